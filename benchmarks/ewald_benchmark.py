@@ -0,0 +1,140 @@
+#! /usr/bin/env python
+"""
+Benchmark of the Ewald summation of Coulomb interactions.
+
+A random neutral system of point charges is evaluated with
+:class:`~pysic.interactions.coulomb.CoulombSummation` in the 'ewald' mode
+(or in the 'pme' mode, if requested with the ``--method`` option)
+and the times spent in calculating the energy, forces and electronegativities
+are reported.
+
+In order to measure the speedup with respect to another version of Pysic,
+give the directory containing that version (i.e., the directory containing the
+``pysic`` package) with the ``--reference`` option. The same system is then
+evaluated with both versions and the results and timings are compared::
+
+ python ewald_benchmark.py --atoms 10000 --reference /path/to/old/build
+"""
+
+import sys
+import os
+import time
+import subprocess
+import optparse
+
+import numpy as np
+
+
+def run(n_atoms, real_cutoff, accuracy, seed, method='ewald'):
+    """Evaluates the benchmark system and returns the timings and results.
+    """
+    import pysic
+    from pysic.interactions.coulomb import CoulombSummation, estimate_ewald_parameters
+    from ase import Atoms
+
+    np.random.seed(seed)
+    # a slightly skewed cell with a density of 0.05 charges / A^3
+    length = (n_atoms/0.05)**(1.0/3.0)
+    cell = length * np.array([[1.0, 0.0, 0.0],
+                              [0.1, 1.0, 0.0],
+                              [0.0, 0.1, 1.0]])
+    positions = np.dot(np.random.random([n_atoms,3]), cell)
+    charges = np.ones(n_atoms)
+    charges[n_atoms/2:] = -1.0
+
+    system = Atoms('Na'+str(n_atoms), positions=positions, cell=cell, pbc=True)
+    # the call for charges was changed between ASE 3.6 and 3.7
+    try:
+        system.set_charges(charges)
+    except:
+        system.set_initial_charges(charges)
+
+    calc = pysic.Pysic()
+    if method == 'pme':
+        from pysic.interactions.coulomb import estimate_pme_parameters
+        summation = CoulombSummation('pme', estimate_pme_parameters(real_cutoff, accuracy))
+    else:
+        summation = CoulombSummation('ewald', estimate_ewald_parameters(real_cutoff, accuracy))
+    calc.set_coulomb_summation(summation)
+    system.set_calculator(calc)
+
+    # initialize the core and the neighbor lists outside the timed region
+    calc.set_atoms(system)
+    calc.set_core()
+
+    t0 = time.time()
+    energy = system.get_potential_energy()
+    t1 = time.time()
+    forces = system.get_forces()
+    t2 = time.time()
+    enegs = calc.get_electronegativities()
+    t3 = time.time()
+
+    return [t1-t0, t2-t1, t3-t2], energy, forces, enegs
+
+
+def run_elsewhere(path, options):
+    """Runs the benchmark in a separate process using the Pysic found in the given directory.
+    """
+    result_file = os.path.join(os.path.abspath(path), 'ewald_benchmark_result.npy')
+    command = [sys.executable, os.path.abspath(__file__),
+               '--atoms', str(options.atoms),
+               '--cutoff', str(options.cutoff),
+               '--accuracy', options.accuracy,
+               '--seed', str(options.seed),
+               '--method', options.method,
+               '--output', result_file]
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.path.abspath(path) + os.pathsep + env.get('PYTHONPATH', '')
+    subprocess.check_call(command, env=env)
+    data = np.load(result_file)
+    os.remove(result_file)
+    n_atoms = options.atoms
+    return list(data[0:3]), data[3], data[4:4+3*n_atoms].reshape(n_atoms,3), data[4+3*n_atoms:]
+
+
+def report(label, times):
+    print "{l:>12}: energy {e:8.3f} s, forces {f:8.3f} s, electronegativities {x:8.3f} s".format(l=label,
+                                                                                               e=times[0],
+                                                                                               f=times[1],
+                                                                                               x=times[2])
+
+
+if __name__ == '__main__':
+
+    parser = optparse.OptionParser()
+    parser.add_option('--atoms', type='int', default=10000,
+                      help='number of charges in the system')
+    parser.add_option('--cutoff', type='float', default=6.0,
+                      help='real space cutoff')
+    parser.add_option('--accuracy', default='normal',
+                      help='accuracy keyword for estimate_ewald_parameters')
+    parser.add_option('--seed', type='int', default=1,
+                      help='random number seed for generating the system')
+    parser.add_option('--method', default='ewald',
+                      help="summation method, 'ewald' or 'pme'")
+    parser.add_option('--reference', default=None,
+                      help='directory containing a reference version of pysic')
+    parser.add_option('--output', default=None,
+                      help=optparse.SUPPRESS_HELP)
+    options, args = parser.parse_args()
+
+    times, energy, forces, enegs = run(options.atoms, options.cutoff, options.accuracy, options.seed, options.method)
+
+    if options.output is not None:
+        np.save(options.output, np.concatenate([times, [energy], forces.ravel(), enegs]))
+        sys.exit(0)
+
+    print "Coulomb summation ({m}) of {n} charges".format(m=options.method, n=options.atoms)
+    report('current', times)
+
+    if options.reference is not None:
+        ref_times, ref_energy, ref_forces, ref_enegs = run_elsewhere(options.reference, options)
+        report('reference', ref_times)
+        print "{l:>12}: energy {e:8.2f} x, forces {f:8.2f} x, electronegativities {x:8.2f} x".format(l='speedup',
+                                                                                                   e=ref_times[0]/times[0],
+                                                                                                   f=ref_times[1]/times[1],
+                                                                                                   x=ref_times[2]/times[2])
+        print "max. difference: energy {e:.3e}, forces {f:.3e}, electronegativities {x:.3e}".format(e=abs(energy-ref_energy),
+                                                                                                     f=abs(forces-ref_forces).max(),
+                                                                                                     x=abs(enegs-ref_enegs).max())
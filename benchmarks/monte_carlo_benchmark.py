@@ -0,0 +1,104 @@
+#! /usr/bin/env python
+"""
+Benchmark of the local energy changes in Monte Carlo simulations.
+
+A slightly disordered simple cubic crystal is simulated with
+:meth:`~pysic.calculator.Pysic.run_monte_carlo` using displacement moves only.
+The atoms interact through a Lennard-Jones potential and, unless the
+``--pair`` option is given, also through the 3-body 'bond_bend' potential.
+The time spent per trial move is compared to the time of evaluating
+the energy of the whole system, and the accumulated energy change is
+checked against the energy of the final structure.
+
+Since the energy change of a trial is calculated locally, the time per trial
+should not grow with the size of the system::
+
+ python monte_carlo_benchmark.py --size 4 8 12 16
+
+The script exits with an error if the accumulated energy change
+is not consistent with the final energy.
+"""
+
+import sys
+import time
+import optparse
+
+import numpy as np
+
+
+def make_system(size, seed):
+    """Creates a disordered simple cubic crystal of size**3 atoms.
+    """
+    from ase import Atoms
+
+    np.random.seed(seed)
+    spacing = 2.5
+    grid = np.array([ [i,j,k] for i in range(size) for j in range(size) for k in range(size) ], dtype=float)
+    positions = spacing*grid + 0.05*np.random.randn(len(grid),3)
+    return Atoms('Ar'+str(len(grid)), positions=positions, cell=np.eye(3)*spacing*size, pbc=True)
+
+
+def make_calculator(pair_only):
+    """Creates the calculator with the Lennard-Jones and bond bending potentials.
+    """
+    import pysic
+
+    calc = pysic.Pysic()
+    potentials = [ pysic.Potential('LJ', symbols=['Ar','Ar'], parameters=[0.01,2.2], cutoff=5.0) ]
+    if not pair_only:
+        potentials.append( pysic.Potential('bond_bend', symbols=['Ar','Ar','Ar'],
+                                           parameters=[0.01,np.pi/2,1,1], cutoff=3.0, cutoff_margin=0.3) )
+    calc.set_potentials(potentials)
+    return calc
+
+
+def run(size, n_trials, pair_only, seed):
+    """Runs the simulation and returns the timings and the energy error.
+    """
+    system = make_system(size, seed)
+    calc = make_calculator(pair_only)
+    system.set_calculator(calc)
+
+    # initialize the core and the neighbor lists outside the timed region
+    calc.set_atoms(system)
+    calc.set_core()
+
+    t0 = time.time()
+    start_energy = system.get_potential_energy()
+    t1 = time.time()
+    attempts, accepted, energy_change = calc.run_monte_carlo(system, n_trials, 0.02,
+                                                             max_displacement=0.1, seed=seed)
+    t2 = time.time()
+
+    fresh = system.copy()
+    fresh.set_calculator(make_calculator(pair_only))
+    error = abs(start_energy + energy_change - fresh.get_potential_energy())
+
+    return t1-t0, (t2-t1)/n_trials, accepted[0], error
+
+
+if __name__ == '__main__':
+
+    parser = optparse.OptionParser()
+    parser.add_option('--size', type='int', nargs=4, default=(4,8,12,16),
+                      help='the numbers of atoms along the sides of the simulated crystals')
+    parser.add_option('--trials', type='int', default=20000,
+                      help='number of trial moves')
+    parser.add_option('--pair', action='store_true', default=False,
+                      help='use the pair potential only')
+    parser.add_option('--seed', type='int', default=1,
+                      help='random number seed')
+    options, args = parser.parse_args()
+
+    failed = False
+    print "Monte Carlo with {p}".format(p='LJ' if options.pair else 'LJ and bond_bend')
+    for size in options.size:
+        energy_time, trial_time, accepted, error = run(size, options.trials, options.pair, options.seed)
+        print "{n:>8} atoms: energy {e:9.3f} ms, trial {t:8.1f} us, {r:9.0f} trials / min, accepted {a:6d}, error {x:.2e}".format(
+            n=size**3, e=1000*energy_time, t=1e6*trial_time, r=60/trial_time, a=accepted, x=error)
+        if error > 1e-6:
+            failed = True
+
+    if failed:
+        print "The accumulated energy change does not match the final energy."
+        sys.exit(1)
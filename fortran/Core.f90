@@ -14,6 +14,8 @@ module pysic_core
   use geometry
   use potentials
   use mpi
+  use mt95
+!$ use omp_lib
   implicit none
   
   ! storage for structure
@@ -21,7 +23,21 @@ module pysic_core
   ! *atoms an array of :data:`atom` objects representing the system
   type(atom), pointer :: atoms(:)
   ! *cell a :data:`supercell` object representing the simulation cell
-  type(supercell) :: cell
+  type(supercell), target :: cell
+  ! *systems_packed logical tag indicating if the atoms form several independent systems, each in its own supercell (see :func:`core_pack_systems`)
+  ! *system_cells the supercells of the packed systems
+  ! *atom_systems the index of the packed system each atom belongs to, indexed by atom index
+  ! *system_energies the potential energies of the packed systems from the latest energy evaluation
+  ! *system_stresses the potential parts of the stress of the packed systems from the latest force evaluation
+  logical :: systems_packed = .false.
+  type(supercell), allocatable, target :: system_cells(:)
+  integer, allocatable :: atom_systems(:)
+  double precision, allocatable :: system_energies(:), system_stresses(:,:)
+  ! *evaluate_atom_contributions logical tag indicating if the energies and virials of individual atoms are collected during the evaluation (see :func:`core_set_atom_contributions`)
+  ! *atom_energies the potential energies of the atoms from the latest energy evaluation, in the order the atoms are stored in the core
+  ! *atom_virials the virials of the atoms from the latest force evaluation, in the order the atoms are stored in the core
+  logical :: evaluate_atom_contributions = .false.
+  double precision, allocatable :: atom_energies(:), atom_virials(:,:)
   ! *interactions an array of :data:`potential` objects representing the interactions
   type(potential), pointer :: interactions(:)
   ! *multipliers a temporary array for storing multiplying potentials before associating them with a master potential
@@ -32,6 +48,9 @@ module pysic_core
   ! *n_bond_order_factors number of bond order factors
   ! *n_multi number of temporary product potentials
   integer :: n_interactions = 0, n_bond_factors = 0, n_multi = 0
+  ! *manybody_potentials_present logical tag indicating if any of the potentials has more than two targets
+  ! *quadruplet_potentials_present logical tag indicating if any of the potentials has four targets
+  logical :: manybody_potentials_present = .false., quadruplet_potentials_present = .false.
   ! logical tags monitoring the allocation and deallocation
   ! of the corresponding pointers
   ! *atoms_created logical tag indicating if atom storing arrays have been created
@@ -84,11 +103,39 @@ module pysic_core
   ! *ewald_epsilon the electric constant :math:`\varepsilon_0` used in Ewald summation
   ! *ewald_scaler scaling factors for individual charges in Ewald summation
   ! *ewald_allocated logical tag for tracking allocation of the arrays
+  ! *evaluate_pme switch for evaluating the reciprocal part of the Ewald summation with the particle mesh Ewald method
+  ! *pme_grid the number of grid points along each cell vector in the particle mesh Ewald method
+  ! *pme_order the order of the B-splines in the particle mesh Ewald method
   logical :: evaluate_ewald = .false.
   integer :: ewald_k_cutoffs(3)
   double precision :: ewald_cutoff, ewald_k_radius, ewald_sigma, ewald_epsilon
   double precision, pointer :: ewald_scaler(:)
   logical :: ewald_allocated = .false.
+  logical :: evaluate_pme = .false.
+  integer :: pme_grid(3), pme_order
+
+
+  ! *neighbor_reference_positions the positions of atoms at the time the neighbor lists were last built, used for tracking how far the atoms have moved since
+  ! *neighbor_reference_set logical tag indicating if the reference positions have been stored for the current atoms
+  double precision, allocatable :: neighbor_reference_positions(:,:)
+  logical :: neighbor_reference_set = .false.
+
+  ! *n_threads the number of threads used in the evaluation of local interactions (only has an effect if the core is compiled with OpenMP)
+  integer :: n_threads = 1
+
+  ! *spatial_ordering logical switch, if true the atoms are reordered along a space-filling curve whenever the space is partitioned for building the neighbor lists (see :func:`core_order_atoms_along_curve`)
+  ! *atom_storage_index the position of each atom in the array atoms: the atom with index i is stored in atoms(atom_storage_index(i))
+  logical :: spatial_ordering = .false.
+  integer, allocatable :: atom_storage_index(:)
+
+  ! *neighbor_list_cutoffs the cutoffs used in the latest build of the neighbor lists
+  ! *neighbor_halo_depth the number of layers of subcells around the domain of this cpu whose atoms got neighbor lists in the latest build
+  ! *neighbor_list_skin the skin width used in the latest build of the neighbor lists, negative if the lists have been given from outside the core
+  double precision, allocatable :: neighbor_list_cutoffs(:)
+  integer :: neighbor_halo_depth = 0
+  double precision :: neighbor_list_skin = -1.d0
+  ! *n_neighbor_distance_checks the number of atom pairs whose distance was checked in the latest build of the neighbor lists
+  integer(kind=8) :: n_neighbor_distance_checks = 0
 
 
   ! indices for specifying the type of quantity evaluated during local structure loops
@@ -110,6 +157,7 @@ contains
     call core_clear_bond_order_factors()
     call core_clear_bond_order_storage()
     call core_clear_ewald_arrays()
+    call clear_stored_tables() ! in Potentials.f90
 
   end subroutine core_release_all_memory
 
@@ -132,10 +180,20 @@ contains
     double precision, intent(in) :: masses(n_atoms), charges(n_atoms), positions(3,n_atoms), &
          momenta(3,n_atoms)
     character(len=label_length), intent(in) :: elements(n_atoms)
+    integer :: i
 
     call generate_atoms(n_atoms,masses,charges,positions,momenta,tags,elements,atoms) ! in Geometry.f90
     number_of_atoms = n_atoms
+    if(allocated(atom_storage_index))then
+       deallocate(atom_storage_index)
+    end if
+    allocate(atom_storage_index(n_atoms))
+    do i = 1, n_atoms
+       atom_storage_index(i) = i
+    end do
     atoms_created = .true.
+    neighbor_reference_set = .false.
+    systems_packed = .false.
 
   end subroutine core_generate_atoms
 
@@ -154,9 +212,28 @@ contains
     integer, intent(in) :: n_atoms
     double precision, intent(in) :: positions(3,n_atoms), momenta(3,n_atoms)
 
-    call update_atomic_positions(n_atoms,positions,momenta,atoms) ! in Geometry.f90
+    call update_atomic_positions(n_atoms,positions,atoms) ! in Geometry.f90
+    call update_atomic_momenta(n_atoms,momenta,atoms) ! in Geometry.f90
 
   end subroutine core_update_atom_coordinates
+
+
+! !!!: core_update_atom_positions
+
+  ! Updates the positions of atomic particles, leaving the momenta as they are.
+  !
+  ! called from PyInterface: :func:`update_atom_positions`
+  !
+  ! *n_atoms number of atoms
+  ! *positions new coordinates for the atoms
+  subroutine core_update_atom_positions(n_atoms,positions)
+    implicit none
+    integer, intent(in) :: n_atoms
+    double precision, intent(in) :: positions(3,n_atoms)
+
+    call update_atomic_positions(n_atoms,positions,atoms) ! in Geometry.f90
+
+  end subroutine core_update_atom_positions
  
 
 ! !!!: core_update_atom_charges
@@ -222,6 +299,13 @@ contains
        deallocate(atoms)
        atoms_created = .false.
     end if
+    if(allocated(neighbor_reference_positions))then
+       deallocate(neighbor_reference_positions)
+    end if
+    if(allocated(atom_storage_index))then
+       deallocate(atom_storage_index)
+    end if
+    neighbor_reference_set = .false.
 
   end subroutine core_clear_atoms
 
@@ -261,6 +345,210 @@ contains
   end subroutine core_get_cell_vectors
 
 
+! !!!: core_cell_of_atom
+
+  ! Returns a pointer to the supercell containing the atom of the given index.
+  ! This is the supercell stored in the core, unless several systems 
+  ! have been packed in the core with :func:`core_pack_systems`,
+  ! in which case it is the supercell of the system the atom belongs to.
+  !
+  ! *index the index of the atom
+  function core_cell_of_atom(index)
+    implicit none
+    integer, intent(in) :: index
+    type(supercell), pointer :: core_cell_of_atom
+
+    if(systems_packed)then
+       core_cell_of_atom => system_cells(atom_systems(index))
+    else
+       core_cell_of_atom => cell
+    end if
+
+  end function core_cell_of_atom
+
+
+! !!!: core_pack_systems
+
+  ! Divides the atoms in the core in several independent systems, each in its 
+  ! own supercell. This way many small structures can be evaluated at once
+  ! without initializing the core separately for each of them.
+  !
+  ! The atoms of each system must be stored consecutively, so that the atoms of
+  ! system i are those from first_atoms(i) to first_atoms(i+1)-1. 
+  ! The neighbor lists of packed systems are built with :func:`core_build_packed_neighbor_lists`,
+  ! which never lists atoms of different systems as neighbors.
+  ! The energies and stresses of the systems are then also summed separately during the 
+  ! evaluation, see :func:`core_get_system_energies` and :func:`core_get_system_stresses`.
+  ! Ewald summation is not supported for packed systems, and it is switched off.
+  !
+  ! The packing is undone when the atoms are created anew with :func:`core_generate_atoms`.
+  !
+  ! called from PyInterface: :func:`pack_systems`
+  !
+  ! *n_systems number of systems
+  ! *first_atoms indices of the first atoms of the systems
+  ! *vectors the vectors spanning the supercells of the systems, as in :func:`core_create_cell`
+  ! *inverses the inverse matrices of the vectors
+  ! *periodicities the periodicities of the systems
+  subroutine core_pack_systems(n_systems,first_atoms,vectors,inverses,periodicities)
+    implicit none
+    integer, intent(in) :: n_systems, first_atoms(n_systems)
+    double precision, intent(in) :: vectors(3,3,n_systems), inverses(3,3,n_systems)
+    logical, intent(in) :: periodicities(3,n_systems)
+    integer :: i, j, last
+
+    if(allocated(system_cells))then
+       deallocate(system_cells)
+       deallocate(atom_systems)
+       deallocate(system_energies)
+       deallocate(system_stresses)
+    end if
+    allocate(system_cells(n_systems))
+    allocate(atom_systems(size(atoms)))
+    allocate(system_energies(n_systems))
+    allocate(system_stresses(6,n_systems))
+
+    do i = 1, n_systems
+       call generate_supercell(vectors(1:3,1:3,i),inverses(1:3,1:3,i),periodicities(1:3,i),&
+            system_cells(i)) ! in Geometry.f90
+       if(i < n_systems)then
+          last = first_atoms(i+1)-1
+       else
+          last = size(atoms)
+       end if
+       do j = first_atoms(i), last
+          atom_systems(atoms(j)%index) = i
+       end do
+    end do
+
+    system_energies = 0.d0
+    system_stresses = 0.d0
+    systems_packed = .true.
+    evaluate_ewald = .false.
+
+  end subroutine core_pack_systems
+
+
+! !!!: core_get_system_energies
+
+  ! Returns the potential energies of the systems packed in the core
+  ! (see :func:`core_pack_systems`) from the latest energy evaluation.
+  !
+  ! called from PyInterface: :func:`get_system_energies`
+  !
+  ! *energies the energies of the systems
+  subroutine core_get_system_energies(energies)
+    implicit none
+    double precision, intent(out) :: energies(:)
+
+    energies = 0.d0
+    if(systems_packed)then
+       energies = system_energies
+    end if
+
+  end subroutine core_get_system_energies
+
+
+! !!!: core_get_system_stresses
+
+  ! Returns the potential parts of the stress of the systems packed in the core
+  ! (see :func:`core_pack_systems`) from the latest force evaluation.
+  ! For each system, the stress is given as in :func:`core_calculate_forces`.
+  !
+  ! called from PyInterface: :func:`get_system_stresses`
+  !
+  ! *stresses the stresses of the systems
+  subroutine core_get_system_stresses(stresses)
+    implicit none
+    double precision, intent(out) :: stresses(:,:)
+
+    stresses = 0.d0
+    if(systems_packed)then
+       stresses = system_stresses
+    end if
+
+  end subroutine core_get_system_stresses
+
+
+! !!!: core_set_atom_contributions
+
+  ! Switches the collection of the energies and virials of individual atoms on or off.
+  !
+  ! When switched on, each energy evaluation stores the potential energies of
+  ! the atoms and each force evaluation the virials of the atoms, obtained
+  ! by dividing the energy and virial of every interacting atom, pair, triplet
+  ! and quadruplet evenly between the atoms involved (see :func:`core_add_tuple_contributions`).
+  ! These are retrieved with :func:`core_get_atom_energies` and :func:`core_get_atom_virials`.
+  !
+  ! called from PyInterface: :func:`set_atom_contributions`
+  !
+  ! *collect true if the contributions of the atoms are collected
+  subroutine core_set_atom_contributions(collect)
+    implicit none
+    logical, intent(in) :: collect
+
+    evaluate_atom_contributions = collect
+
+  end subroutine core_set_atom_contributions
+
+
+! !!!: core_get_atom_energies
+
+  ! Returns the potential energies of the atoms from the latest energy evaluation
+  ! during which the contributions of the atoms were collected
+  ! (see :func:`core_set_atom_contributions`).
+  ! The energies are in the order the atoms are stored in the core.
+  ! They add up to the total potential energy.
+  !
+  ! The reciprocal space part of the Ewald summation is divided between the atoms as 
+  ! :math:`E_i = -\frac{1}{2} q_i \chi_i`, where :math:`\chi_i` is the reciprocal space
+  ! part of the electronegativity of the atom.
+  !
+  ! called from PyInterface: :func:`get_atom_energies`
+  !
+  ! *energies the energies of the atoms
+  subroutine core_get_atom_energies(energies)
+    implicit none
+    double precision, intent(out) :: energies(:)
+
+    energies = 0.d0
+    if(allocated(atom_energies))then
+       if(size(atom_energies) == size(energies))then
+          energies = atom_energies
+       end if
+    end if
+
+  end subroutine core_get_atom_energies
+
+
+! !!!: core_get_atom_virials
+
+  ! Returns the virials of the atoms from the latest force evaluation
+  ! during which the contributions of the atoms were collected
+  ! (see :func:`core_set_atom_contributions`).
+  ! The virials are in the order the atoms are stored in the core and given
+  ! in the same format as the stress in :func:`core_calculate_forces`,
+  ! so that they add up to it.
+  ! 
+  ! The reciprocal space part of the Ewald summation is divided evenly between the atoms.
+  !
+  ! called from PyInterface: :func:`get_atom_virials`
+  !
+  ! *virials the virials of the atoms
+  subroutine core_get_atom_virials(virials)
+    implicit none
+    double precision, intent(out) :: virials(:,:)
+
+    virials = 0.d0
+    if(allocated(atom_virials))then
+       if(size(atom_virials,2) == size(virials,2))then
+          virials = atom_virials
+       end if
+    end if
+
+  end subroutine core_get_atom_virials
+
+
 ! !!!: core_create_neighbor_list
 
   ! Assigns a precalculated neighbor list to a single atom of the given index.
@@ -298,6 +586,9 @@ contains
   ! principle appear several times in the neighbor list with
   ! different offsets.
   !
+  ! Lists given this way are not divided in tiers
+  ! (see :func:`core_divide_neighbor_lists_in_tiers`).
+  !
   ! called from PyInterface: :func:`create_neighbor_list`
   !
   ! *n_nbs number of neighbors
@@ -309,7 +600,10 @@ contains
     integer, intent(in) :: n_nbors, atom_index
     integer, intent(in) :: neighbors(n_nbors), offsets(3,n_nbors)
 
-    call assign_neighbor_list(n_nbors,atoms(atom_index)%neighbor_list,neighbors,offsets)
+    call assign_neighbor_list(n_nbors,atoms(atom_index)%neighbor_list,neighbors,offsets) ! in Geometry.f90
+    ! the skin of lists built outside the core is not known,
+    ! so they cannot be divided in tiers
+    neighbor_list_skin = -1.d0
 
   end subroutine core_create_neighbor_list
 
@@ -331,7 +625,12 @@ contains
           deallocate(interactions(i)%original_tags)
           deallocate(interactions(i)%original_indices)
           deallocate(interactions(i)%derived_parameters)  
-          deallocate(interactions(i)%table)
+          ! shared tables are released with the stored tables
+          if(interactions(i)%shared_table)then
+             nullify(interactions(i)%table)
+          else
+             deallocate(interactions(i)%table)
+          end if
           deallocate(interactions(i)%multipliers)
        end do
     end if
@@ -369,6 +668,11 @@ contains
           deallocate(bond_factors(i)%apply_elements)
           deallocate(bond_factors(i)%original_elements)
           deallocate(bond_factors(i)%derived_parameters)  
+          if(bond_factors(i)%shared_table)then
+             nullify(bond_factors(i)%table)
+          else
+             deallocate(bond_factors(i)%table)
+          end if
        end do
     end if
     if(bond_factors_allocated)then
@@ -786,6 +1090,8 @@ contains
 ! !!!: core_get_bond_order_factor_of_atom
 
   ! Returns the bond order factors of the given atom for the given group.
+  ! If the factors have been stored, the value is looked up directly
+  ! without copying the factors of all atoms.
   !
   ! *n_atoms number of atoms
   ! *group_index index for the bond order factor group
@@ -795,7 +1101,15 @@ contains
     implicit none
     integer, intent(in) :: group_index, atom_index
     double precision, intent(inout) :: bond_order_factor
+    integer :: save_slot
 
+    if(use_saved_bond_order_factors)then
+       save_slot = group_index_save_slot(group_index)
+       if(save_slot > 0)then
+          bond_order_factor = saved_bond_order_factors(atom_index,save_slot)
+          return
+       end if
+    end if
     call core_get_bond_order_factors(group_index,bo_factors)
     bond_order_factor = bo_factors(atom_index)
 
@@ -963,6 +1277,269 @@ contains
 
 
 
+! !!!: core_evaluate_pair_potential
+
+  ! Evaluates a pair potential as a function of the distance of two atoms.
+  !
+  ! A temporary potential is created from the given parameters as in
+  ! :func:`core_add_potential` and its energy :math:`V(r)` and derivative
+  ! :math:`dV/dr` are evaluated at the given distances, including
+  ! the smooth cutoff if the soft cutoff is below the hard one.
+  ! The hard cutoff is not applied, so the values at the cutoff itself
+  ! are the limits from below.
+  ! The atoms are given no charges or other properties, so only potentials
+  ! depending on the distance alone can be evaluated meaningfully.
+  ! This is used for tabulating combinations of pair potentials.
+  !
+  ! called from PyInterface: :func:`evaluate_pair_potential`
+  !
+  ! *n_params number of parameters
+  ! *pot_name potential names
+  ! *parameters numeric parameters
+  ! *cutoff interaction hard cutoff
+  ! *smooth_cut interaction soft cutoff
+  ! *n_r number of distances
+  ! *distances the distances at which the potential is evaluated
+  ! *energies the energies :math:`V(r)`
+  ! *derivatives the derivatives :math:`dV/dr`
+  ! *success logical tag specifying if the potential could be evaluated
+  subroutine core_evaluate_pair_potential(n_params,pot_name,parameters,cutoff,smooth_cut,&
+       n_r,distances,energies,derivatives,success)
+    implicit none
+    integer, intent(in) :: n_params, n_r
+    character(len=*), intent(in) :: pot_name
+    double precision, intent(in) :: parameters(n_params)
+    double precision, intent(in) :: cutoff, smooth_cut, distances(n_r)
+    double precision, intent(out) :: energies(n_r), derivatives(n_r)
+    logical, intent(out) :: success
+    type(potential) :: pair_potential, dummy_multiplier(0)
+    type(atom) :: pair(2)
+    character(len=label_length) :: elements(2)
+    integer :: tags(2), indices(2), n_targets, i
+    double precision :: separation(3,1), force(3,2), factor, factor_derivative
+    logical :: smoothen
+
+    energies = 0.d0
+    derivatives = 0.d0
+    elements = no_name
+    tags = -9
+    indices = -9
+    call create_potential(2,n_params,&
+         pot_name,parameters,cutoff,smooth_cut,&
+         elements,tags,indices,&
+         elements,tags,indices,-1,&
+         0,dummy_multiplier,&
+         pair_potential,success) ! in Potentials.f90
+    if(.not. success)then
+       return
+    end if
+
+    call get_number_of_targets_of_potential_index(pair_potential%type_index,&
+         n_targets) ! in Potentials.f90
+    if(n_targets /= 2)then
+       success = .false.
+    else
+       pair(1:2)%charge = 0.d0
+       pair(1:2)%element = no_name
+       smoothen = pair_potential%smoothened
+       do i = 1, n_r
+          ! atom 2 sits at distance r from atom 1 along x,
+          ! so the x component of the force on atom 1 is dV/dr
+          separation(1:3,1) = (/ distances(i), 0.d0, 0.d0 /)
+          call evaluate_energy(2,1,separation(1:3,1),distances(i),&
+               pair_potential,energies(i),pair) ! in Potentials.f90
+          call evaluate_forces(2,1,separation(1:3,1),distances(i),&
+               pair_potential,force,pair) ! in Potentials.f90
+          derivatives(i) = force(1,1)
+          if(smoothen)then
+             call smoothening_factor(distances(i),&
+                  pair_potential%cutoff,pair_potential%soft_cutoff,&
+                  factor) ! in Potentials.f90
+             call smoothening_derivative(distances(i),&
+                  pair_potential%cutoff,pair_potential%soft_cutoff,&
+                  factor_derivative) ! in Potentials.f90
+             derivatives(i) = derivatives(i)*factor + energies(i)*factor_derivative
+             energies(i) = energies(i)*factor
+          end if
+       end do
+    end if
+
+    deallocate(pair_potential%parameters)
+    deallocate(pair_potential%apply_elements)
+    deallocate(pair_potential%apply_tags)
+    deallocate(pair_potential%apply_indices)
+    deallocate(pair_potential%original_elements)
+    deallocate(pair_potential%original_tags)
+    deallocate(pair_potential%original_indices)
+    deallocate(pair_potential%derived_parameters)
+    if(pair_potential%shared_table)then
+       nullify(pair_potential%table)
+    else
+       deallocate(pair_potential%table)
+    end if
+    deallocate(pair_potential%multipliers)
+
+  end subroutine core_evaluate_pair_potential
+
+
+
+! !!!: core_set_potential_parameters
+
+  ! Replaces the numeric parameters of a potential already created in the core.
+  !
+  ! Only the parameter values are changed, so the per-atom potential lists,
+  ! the bond order storage and the neighbor lists remain valid.
+  ! The potentials are identified by their order of creation with :func:`core_add_potential`.
+  ! The multipliers of product potentials are stored in the potentials they
+  ! multiply, in the order they were added. Since the multipliers share their
+  ! parameters with all the potentials created while they were active, updating
+  ! a multiplier through one potential updates it in all of them.
+  !
+  ! called from PyInterface: :func:`set_potential_parameters`
+  !
+  ! *index index of the potential
+  ! *multiplier index of the multiplier, 0 for the potential itself
+  ! *n_params number of parameters
+  ! *parameters the new numeric parameters
+  ! *success logical tag specifying if the update succeeded
+  subroutine core_set_potential_parameters(index,multiplier,n_params,parameters,success)
+    implicit none
+    integer, intent(in) :: index, multiplier, n_params
+    double precision, intent(in) :: parameters(n_params)
+    logical, intent(out) :: success
+
+    success = .false.
+    if(index < 1 .or. index > n_interactions)then
+       return
+    end if
+
+    if(multiplier < 1)then
+       call update_potential_parameters(n_params,parameters,interactions(index),success) ! in Potentials.f90
+    else if(multiplier < interactions(index)%n_product)then
+       call update_potential_parameters(n_params,parameters,&
+            interactions(index)%multipliers(multiplier),success) ! in Potentials.f90
+    end if
+
+  end subroutine core_set_potential_parameters
+
+
+
+! !!!: core_set_parameter_derivative
+
+  ! Marks a parameter of a potential for differentiation.
+  !
+  ! In the parameter derivative mode, switched on with :func:`core_set_parameter_derivative_mode`,
+  ! the energy and force calculations return the derivatives of the energy and forces
+  ! with respect to the marked parameter instead of the energy and forces.
+  ! The potential is identified as in :func:`core_set_potential_parameters`.
+  ! Since the multipliers of product potentials are stored separately in each
+  ! potential, a multiplier must be marked in every potential it multiplies.
+  !
+  ! called from PyInterface: :func:`set_parameter_derivative`
+  !
+  ! *index index of the potential
+  ! *multiplier index of the multiplier, 0 for the potential itself
+  ! *param index of the parameter, 0 to remove the mark
+  ! *success logical tag specifying if the marking succeeded
+  subroutine core_set_parameter_derivative(index,multiplier,param,success)
+    implicit none
+    integer, intent(in) :: index, multiplier, param
+    logical, intent(out) :: success
+
+    success = .false.
+    if(index < 1 .or. index > n_interactions)then
+       return
+    end if
+
+    if(multiplier < 1)then
+       if(param <= size(interactions(index)%parameters))then
+          interactions(index)%derivative_parameter = param
+          success = .true.
+       end if
+    else if(multiplier < interactions(index)%n_product)then
+       if(param <= size(interactions(index)%multipliers(multiplier)%parameters))then
+          interactions(index)%multipliers(multiplier)%derivative_parameter = param
+          success = .true.
+       end if
+    end if
+
+  end subroutine core_set_parameter_derivative
+
+
+
+! !!!: core_set_parameter_derivative_mode
+
+  ! Switches the parameter derivative mode on or off.
+  !
+  ! In the parameter derivative mode, :func:`core_calculate_energy` and :func:`core_calculate_forces`
+  ! calculate the derivatives of the energy, forces and stress with respect to the
+  ! parameters marked with :func:`core_set_parameter_derivative`. The Coulomb summation
+  ! is skipped, since it does not depend on the parameters of the potentials.
+  ! Switching the mode off removes all the marks.
+  !
+  ! called from PyInterface: :func:`set_parameter_derivative_mode`
+  !
+  ! *derivatives true for switching the mode on, false for switching it off
+  subroutine core_set_parameter_derivative_mode(derivatives)
+    implicit none
+    logical, intent(in) :: derivatives
+    integer :: i, j
+
+    parameter_derivative_mode = derivatives
+    if(.not. derivatives)then
+       do i = 1, n_interactions
+          interactions(i)%derivative_parameter = 0
+          do j = 1, interactions(i)%n_product-1
+             interactions(i)%multipliers(j)%derivative_parameter = 0
+          end do
+       end do
+    end if
+
+  end subroutine core_set_parameter_derivative_mode
+
+
+
+! !!!: core_store_table
+
+  ! Stores a table of values to be shared by tabulated potentials and bond order factors.
+  !
+  ! Potentials and bond order factors created with the id -index
+  ! use the stored table instead of reading one from a file.
+  !
+  ! called from PyInterface: :func:`store_table`
+  !
+  ! *index the index of the stored table
+  ! *n_values the number of tabulated values
+  ! *values the tabulated values and scaled derivatives, as rows
+  subroutine core_store_table(index,n_values,values)
+    implicit none
+    integer, intent(in) :: index, n_values
+    double precision, intent(in) :: values(2,n_values)
+
+    call add_stored_table(index,n_values,values) ! in Potentials.f90
+
+  end subroutine core_store_table
+
+
+! !!!: core_remove_table
+
+  ! Releases a table stored with :func:`core_store_table`.
+  !
+  ! The table must not be used by any potential or bond order factor.
+  !
+  ! called from PyInterface: :func:`remove_table`
+  !
+  ! *index the index of the stored table
+  subroutine core_remove_table(index)
+    implicit none
+    integer, intent(in) :: index
+
+    call remove_stored_table(index) ! in Potentials.f90
+
+  end subroutine core_remove_table
+
+
+
 ! !!!: core_add_bond_order_factor
 
   ! Creates one additional bond_order_factor in the core.
@@ -1021,6 +1598,57 @@ contains
   end subroutine core_add_bond_order_factor
 
 
+
+! !!!: core_set_bond_order_parameters
+
+  ! Replaces the numeric parameters of a bond order factor already created in the core.
+  !
+  ! As in :func:`core_set_potential_parameters`, only the parameter values are changed.
+  ! The bond order factors are identified by their order of creation with 
+  ! :func:`core_add_bond_order_factor`. Since tabulated factors read their values
+  ! from a file, their table cannot be changed this way.
+  !
+  ! called from PyInterface: :func:`set_bond_order_parameters`
+  !
+  ! *index index of the bond order factor
+  ! *n_params number of parameters
+  ! *parameters the new numeric parameters, the 1-body parameters first, then the 2-body parameters etc.
+  ! *success logical tag specifying if the update succeeded
+  subroutine core_set_bond_order_parameters(index,n_params,parameters,success)
+    implicit none
+    integer, intent(in) :: index, n_params
+    double precision, intent(in) :: parameters(n_params)
+    logical, intent(out) :: success
+    integer :: i, accumulated_split
+
+    success = .false.
+    if(index < 1 .or. index > n_bond_factors)then
+       return
+    end if
+    if(sum(bond_factors(index)%n_params) /= n_params)then
+       return
+    end if
+
+    accumulated_split = 0
+    do i = 1, size(bond_factors(index)%n_params)
+       if(bond_factors(index)%n_params(i) > 0 .and. accumulated_split == 0)then
+          ! the first parameter of a tabulated factor specifies the table
+          if(bond_factors(index)%type_index == table_bond_index .or. &
+               bond_factors(index)%type_index == table_scale_index)then
+             if(parameters(1) /= bond_factors(index)%parameters(1,i))then
+                return
+             end if
+          end if
+       end if
+       bond_factors(index)%parameters(1:bond_factors(index)%n_params(i),i) = &
+            parameters(accumulated_split+1:accumulated_split+bond_factors(index)%n_params(i))
+       accumulated_split = accumulated_split + bond_factors(index)%n_params(i)
+    end do
+    success = .true.
+
+  end subroutine core_set_bond_order_parameters
+
+
 ! !!!: core_assign_bond_order_factor_indices
 
   ! This routine finds for each atom the potentials for which the
@@ -1033,44 +1661,67 @@ contains
   ! called from PyInterface: :func:`create_bond_order_factor_list`
   subroutine core_assign_bond_order_factor_indices()
     implicit none
+    integer :: i
+
+    do i = 1, size(atoms)       
+       call core_assign_bond_order_factor_indices_of_atom(i)
+    end do
+
+    ! in MPI, bond order factors may require more halo neighbor lists
+    call core_check_halo_depth()
+    ! the tiers of the neighbor lists depend on the cutoffs
+    call core_divide_neighbor_lists_in_tiers()
+
+  end subroutine core_assign_bond_order_factor_indices
+
+
+! !!!: core_assign_bond_order_factor_indices_of_atom
+
+  ! Finds the bond order factors for which the given atom is an accepted
+  ! target at the first position, as :func:`core_assign_bond_order_factor_indices`
+  ! does for all atoms. This is needed separately when the element of
+  ! a single atom changes, see :func:`core_swap_atom_species`.
+  !
+  ! *index1 the index of the atom
+  subroutine core_assign_bond_order_factor_indices_of_atom(index1)
+    implicit none
+    integer, intent(in) :: index1
     logical :: affects(n_bond_factors)
-    integer :: i, j, k, total
+    integer :: j, k, total
     integer, allocatable :: bond_indices(:)
     double precision :: test_cut, max_cut
 
-    do i = 1, size(atoms)       
-       total = 0
-       max_cut = 0.d0
-       test_cut = 0.d0
-       do j = 1, n_bond_factors
-          call bond_order_factor_affects_atom(bond_factors(j),atoms(i),affects(j),1) ! in Potentials.f90
-          if(affects(j))then
-             total = total+1
-             test_cut = bond_factors(j)%cutoff
-             if(test_cut > max_cut)then
-                max_cut = test_cut
-             end if
-          end if
-       end do
-
-       allocate(bond_indices(total))
-       
-       k = 0
-       do j = 1, n_bond_factors
-          if(affects(j))then
-             k = k+1
-             bond_indices(k) = j
+    total = 0
+    max_cut = 0.d0
+    test_cut = 0.d0
+    do j = 1, n_bond_factors
+       call bond_order_factor_affects_atom(bond_factors(j),atoms(index1),affects(j),1) ! in Potentials.f90
+       if(affects(j))then
+          total = total+1
+          test_cut = bond_factors(j)%cutoff
+          if(test_cut > max_cut)then
+             max_cut = test_cut
           end if
-       end do
+       end if
+    end do
 
-       ! pointer allocations are handled in the subroutine
-       call assign_bond_order_factor_indices(total,atoms(i),bond_indices) ! in Potentials.f90
-       call assign_max_bond_order_factor_cutoff(atoms(i),max_cut)
+    allocate(bond_indices(total))
 
-       deallocate(bond_indices)
+    k = 0
+    do j = 1, n_bond_factors
+       if(affects(j))then
+          k = k+1
+          bond_indices(k) = j
+       end if
     end do
 
-  end subroutine core_assign_bond_order_factor_indices
+    ! pointer allocations are handled in the subroutine
+    call assign_bond_order_factor_indices(total,atoms(index1),bond_indices) ! in Potentials.f90
+    call assign_max_bond_order_factor_cutoff(atoms(index1),max_cut)
+
+    deallocate(bond_indices)
+
+  end subroutine core_assign_bond_order_factor_indices_of_atom
 
 
 ! !!!: core_assign_potential_indices
@@ -1085,44 +1736,81 @@ contains
   ! called from PyInterface: :func:`create_potential_list`
   subroutine core_assign_potential_indices()
     implicit none
-    logical :: affects(n_interactions)
-    integer :: i, j, k, total
-    integer, allocatable :: pot_indices(:)
-    double precision :: test_cut, max_cut
+    integer :: i, n_targets
     
     do i = 1, size(atoms)       
-       total = 0
-       max_cut = 0.d0
-       test_cut = 0.d0
-       do j = 1, n_interactions
-          call potential_affects_atom(interactions(j),atoms(i),affects(j),1) ! in Potentials.f90
-          if(affects(j))then
-             total = total+1
-             test_cut = interactions(j)%cutoff
-             if(test_cut > max_cut)then
-                max_cut = test_cut
-             end if
-          end if
-       end do
+       call core_assign_potential_indices_of_atom(i)
+    end do
 
-       allocate(pot_indices(total))
-       
-       k = 0
-       do j = 1, n_interactions
-          if(affects(j))then
-             k = k+1
-             pot_indices(k) = j
-          end if
-       end do
+    ! note if there are potentials with more than two or three targets
+    manybody_potentials_present = .false.
+    quadruplet_potentials_present = .false.
+    do i = 1, n_interactions
+       call get_number_of_targets_of_potential_index(interactions(i)%type_index,&
+            n_targets) ! in Potentials.f90
+       if(n_targets > 2)then
+          manybody_potentials_present = .true.
+       end if
+       if(n_targets > 3)then
+          quadruplet_potentials_present = .true.
+       end if
+    end do
 
-       ! pointer allocations are handled in the subroutine
-       call assign_potential_indices(total,atoms(i),pot_indices) ! in Potentials.f90
-       call assign_max_potential_cutoff(atoms(i),max_cut)
+    ! in MPI, many-body potentials may require more halo neighbor lists
+    call core_check_halo_depth()
+    ! the tiers of the neighbor lists depend on the cutoffs
+    call core_divide_neighbor_lists_in_tiers()
 
-       deallocate(pot_indices)
+  end subroutine core_assign_potential_indices
+
+
+! !!!: core_assign_potential_indices_of_atom
+
+  ! Finds the potentials for which the given atom is an accepted
+  ! target at the first position, as :func:`core_assign_potential_indices`
+  ! does for all atoms. This is needed separately when the element of
+  ! a single atom changes, see :func:`core_swap_atom_species`.
+  !
+  ! *index1 the index of the atom
+  subroutine core_assign_potential_indices_of_atom(index1)
+    implicit none
+    integer, intent(in) :: index1
+    logical :: affects(n_interactions)
+    integer :: j, k, total
+    integer, allocatable :: pot_indices(:)
+    double precision :: test_cut, max_cut
+
+    total = 0
+    max_cut = 0.d0
+    test_cut = 0.d0
+    do j = 1, n_interactions
+       call potential_affects_atom(interactions(j),atoms(index1),affects(j),1) ! in Potentials.f90
+       if(affects(j))then
+          total = total+1
+          test_cut = interactions(j)%cutoff
+          if(test_cut > max_cut)then
+             max_cut = test_cut
+          end if
+       end if
     end do
 
-  end subroutine core_assign_potential_indices
+    allocate(pot_indices(total))
+
+    k = 0
+    do j = 1, n_interactions
+       if(affects(j))then
+          k = k+1
+          pot_indices(k) = j
+       end if
+    end do
+
+    ! pointer allocations are handled in the subroutine
+    call assign_potential_indices(total,atoms(index1),pot_indices) ! in Potentials.f90
+    call assign_max_potential_cutoff(atoms(index1),max_cut)
+
+    deallocate(pot_indices)
+
+  end subroutine core_assign_potential_indices_of_atom
 
 
 
@@ -1198,7 +1886,7 @@ contains
     bond_indices => atom1%bond_indices
           
     ! loop over neighbors
-    do j = 1, nbors1%n_neighbors
+    do j = 1, neighbors_within(nbors1,atom1%max_bond_radius)
        
        ! neighboring atom
        index2 = nbors1%neighbors(j)          
@@ -1211,7 +1899,7 @@ contains
        call separation_vector(atom1%position, &
             atom2%position, &
             nbors1%pbc_offsets(1:3,j), &
-            cell, &
+            core_cell_of_atom(atom1%index), &
             separations(1:3,1)) ! in Geometry.f90
        distances(1) = .norm.(separations(1:3,1))
        if(distances(1) == 0.d0)then
@@ -1316,7 +2004,7 @@ contains
           separations(1:3,1) = -separations(1:3,1)
 
           ! loop over neighbors of atom 1
-          do l = 1, nbors1%n_neighbors
+          do l = 1, neighbors_within(nbors1,atom1%max_bond_radius)
              index3 = nbors1%neighbors(l)
 
              ! Since we first loop over the neighbors of atom1 to get atom2 candidates
@@ -1391,7 +2079,7 @@ contains
                                   call separation_vector(atom1%position, &
                                        atom3%position, &
                                        nbors1%pbc_offsets(1:3,j), &
-                                       cell, &
+                                       core_cell_of_atom(atom1%index), &
                                        separations(1:3,2)) ! in Geometry.f90
                                   separation3_unknown = .false.
                                   distances(2) = .norm.(separations(1:3,2))
@@ -1479,7 +2167,7 @@ contains
           separations(1:3,1) = -separations(1:3,1)
 
           ! loop over neighbors of atom 2
-          do l = 1, nbors2%n_neighbors
+          do l = 1, neighbors_within(nbors2,atom1%max_bond_radius)
              index3 = nbors2%neighbors(l)
 
              ! In the similar loop above, we filter by index3 > index2 to
@@ -1542,7 +2230,7 @@ contains
                                    call separation_vector(atom2%position, &
                                         atom3%position, &
                                         nbors2%pbc_offsets(1:3,l), &
-                                        cell, &
+                                        core_cell_of_atom(atom2%index), &
                                         separations(1:3,2)) ! in Geometry.f90
                                    separation3_unknown = .false.
                                    distances(2) = .norm.(separations(1:3,2))
@@ -1724,7 +2412,7 @@ contains
         
 
     ! loop over neighbors of atom 1
-    do j = 1, nbors1%n_neighbors
+    do j = 1, neighbors_within(nbors1,atom1%max_bond_radius)
        
        ! neighboring atom
        index3 = nbors1%neighbors(j)
@@ -1738,7 +2426,7 @@ contains
        call separation_vector(atom1%position, &
             atom3%position, &
             offset(1:3), &
-            cell, &
+            core_cell_of_atom(atom1%index), &
             separations(1:3,2)) ! in Geometry.f90
        distances(2) = .norm.(separations(1:3,2))
        if(distances(2) == 0.d0)then
@@ -1829,7 +2517,7 @@ contains
     directions(1:3,1) = -directions(1:3,1)
 
     ! loop over neighbors of atom 2
-    do j = 1, nbors2%n_neighbors
+    do j = 1, neighbors_within(nbors2,atom2%max_bond_radius)
        
        ! neighboring atom
        index3 = nbors2%neighbors(j)
@@ -1843,7 +2531,7 @@ contains
        call separation_vector(atom2%position, &
             atom3%position, &
             offset(1:3), &
-            cell, &
+            core_cell_of_atom(atom2%index), &
             separations(1:3,2)) ! in Geometry.f90
        distances(2) = .norm.(separations(1:3,2))
        if(distances(2) == 0.d0)then
@@ -2016,17 +2704,7 @@ contains
     implicit none
     integer, intent(in) :: group_index
     double precision, intent(inout) :: total_bond_orders(:)
-    integer :: index1, index2, index3, k1, k2, j, l, n_targets
-    double precision :: separations(3,2), distances(2), directions(3,2)
-    double precision :: tmp_factor(3)
-    type(atom) :: atom1, atom2, atom3
-    type(atom) :: atom_list(3)
-    type(neighbor_list) :: nbors1, nbors2
-    type(bond_order_parameters) :: bond_params(2)
-    integer, pointer :: bond_indices(:), bond_indices2(:)
-    logical :: is_active, is_in_group, many_bodies_found, separation3_unknown
-    integer :: offset(3), n_atoms
-
+    integer :: index1, n_atoms
 
     n_atoms = size(atoms)
     bo_temp = 0.d0
@@ -2037,371 +2715,400 @@ contains
        
        ! in MPI, only consider the atoms allocated to this particular cpu
        if(is_my_atom(index1))then
+          call core_add_bond_order_sums_of_atom(group_index,index1,bo_temp)
+       end if
 
-          ! target atom
-          atom1 = atoms(index1)
-          nbors1 = atom1%neighbor_list
-          bond_indices => atom1%bond_indices
+    end do ! index1 = 1, size(atoms) 
 
-          ! loop over neighbors
-          do j = 1, nbors1%n_neighbors
-
-             ! neighboring atom
-             index2 = nbors1%neighbors(j)
-             offset(1:3) = nbors1%pbc_offsets(1:3,j)
-
-             ! Since we loop over the neighbors of all atoms, we will find the pair
-             ! atom1-atom2 = atom2-atom1 twice.
-             ! To prevent the double counting, we filter by index2 > index1.
-             if(pick(index1,index2,offset))then
-
-                atom2 = atoms(index2)
-                atom_list(1) = atom1
-                atom_list(2) = atom2
-
-                ! calculate atom1-atom2 separation vector
-                ! and distance
-                call separation_vector(atom1%position, &
-                     atom2%position, &
-                     nbors1%pbc_offsets(1:3,j), &
-                     cell, &
-                     separations(1:3,1)) ! in Geometry.f90
-                distances(1) = .norm.(separations(1:3,1))
-                if(distances(1) == 0.d0)then
-                   directions(1:3,1) = (/ 0.d0, 0.d0, 0.d0 /)
-                else
-                   directions(1:3,1) = separations(1:3,1) / distances(1)
-                end if
+#ifdef MPI
+    ! sum the contributions from all the processors
+    call mpi_allreduce(bo_temp,total_bond_orders,size(total_bond_orders),mpi_double_precision,&
+         mpi_sum,mpi_comm_world,mpistat)
+#else
+    total_bond_orders = bo_temp
+#endif
 
-                many_bodies_found = .false.
+  end subroutine core_calculate_bond_order_factors
 
-                !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
-                ! apply 2-body bond order factors !
-                !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
 
-                if(distances(1) < atom1%max_bond_radius)then
+! !!!: core_add_bond_order_sums_of_atom
 
-                   ! loop over bond order factors affecting atom1
-                   do k1 = 1, size(bond_indices)
-                      
-                      bond_params(1) = bond_factors(bond_indices(k1))
-                      
-                      ! filter the bond indices before applying by checking:
-                      ! number of targets,
-                      ! is atom2 affected by the factor,
-                      ! is the factor in the correct group
-                      if( bond_params(1)%n_level == 1)then
-                         call bond_order_factor_is_in_group(bond_params(1),group_index,is_in_group) ! in Potentials.f90
-                         if( is_in_group .and. bond_params(1)%cutoff > distances(1) )then
-                            call bond_order_factor_affects_atom(bond_params(1),atom2,is_active,2) ! in Potentials.f90
-                            if( is_active )then 
-                               call get_number_of_targets_of_bond_order_factor_index(bond_params(1)%type_index,&
-                                    n_targets) ! in Potentials.f90
-                               if( n_targets == 2 )then
-                                  
-                                  ! evaluate the atom1-atom2 term in the bond order factor sum
-                                  call evaluate_bond_order_factor(2,separations(1:3,1),&
-                                       distances(1),&
-                                       bond_params(1),&
-                                       tmp_factor(1:2),&
-                                       atom_list(1:2)) ! in Potentials.f90
-                                  
-                                  bo_temp(index1) = bo_temp(index1) + tmp_factor(1)
-                                  bo_temp(index2) = bo_temp(index2) + tmp_factor(2)
-                                  
-                               else if( n_targets > 2 )then
-                                  
-                                  ! If the number of targets is greater than 2,
-                                  ! we have found a many-body bond order factor.
-                                  ! Make a note that we must also evaluate the many-body factors.
-                                  many_bodies_found = .true.
-                                  
-                               end if ! n_targets == 2
-                            end if ! is_active
-                         end if ! is_in_group
-                      end if ! n_level == 1
+  ! Adds the terms of the bond order sums from the pairs and triplets
+  ! found starting from the given atom, as in :func:`core_calculate_bond_order_factors`.
+  ! Since the pairs are picked with :func:`pick`, summing over all atoms
+  ! gives every term exactly once. The terms are added to the sums
+  ! of all the atoms they involve.
+  !
+  ! *group_index an index denoting the potential to which the factor is connected
+  ! *index1 index of the atom
+  ! *sums the bond order sums of all atoms, to which the terms are added
+  subroutine core_add_bond_order_sums_of_atom(group_index,index1,sums)
+    implicit none
+    integer, intent(in) :: group_index, index1
+    double precision, intent(inout) :: sums(:)
+    integer :: index2, index3, k1, k2, j, l, n_targets
+    double precision :: separations(3,2), distances(2), directions(3,2)
+    double precision :: tmp_factor(3)
+    type(atom) :: atom1, atom2, atom3
+    type(atom) :: atom_list(3)
+    type(neighbor_list) :: nbors1, nbors2
+    type(bond_order_parameters) :: bond_params(2)
+    integer, pointer :: bond_indices(:), bond_indices2(:)
+    logical :: is_active, is_in_group, many_bodies_found, separation3_unknown
+    integer :: offset(3)
 
-                   end do ! k1 = 1, size(bond_indices)
-                end if ! distance < max_cut
+    ! target atom
+    atom1 = atoms(index1)
+    nbors1 = atom1%neighbor_list
+    bond_indices => atom1%bond_indices
 
-                ! Only do the 3-body loop if we found many-body factors 
-                ! during 2-body evaluation.
-                ! 
-                ! In the 3-body loop, we search the neighbors of both atom1
-                ! and atom2 to find the triplets 
-                ! atom1-atom2-atom3 and
-                ! atom2-atom1-atom3
-                ! These are considered to be different, since the middle atom of
-                ! the triplet is different (atom2 vs. atom1).
-                !
-                ! We loop over all atoms to get atom1, 
-                ! then over the neighbors of the atom1 to get atom2,
-                ! then again over the neighbors of both atom1 and atom2 to get atom3.
-                ! We want to find every triplet A-B-C, B-A-C, A-C-B exactly once filtering by the
-                ! ordering of the indices of the atoms.
-                ! Triplets A-B-C are considered equal to C-B-A and should be only found once.
-                !
-                ! Consider the indices A: 1, B: 2, C: 3. For other orderings, we can just
-                ! permutate the names A, B and C so this is not affecting the generality
-                ! of the argument.
-                !
-                ! We already filter by index1 < index2 when searching for atom2.
-                ! Therefore the possible ways to get atom1 and atom2 for these orderings are:
-                !
-                !  A B C   atom1 atom2  or  atom1 atom2  or  atom1 atom2 
-                !  1 2 3   A : 1 B : 2      A : 1 C : 3      B : 2 C : 3
-                !
-                ! If we filter atom3 by index3 > index2 when searching atom1 neighbors
-                ! and index3 > index1 when searching atom2 neighbors (i.e., index3
-                ! greater than the index of the atom whose neighbors are not searched),
-                ! we get:
-                !
-                !  A B C   atom1 atom2  atom3 as atom1 nbor / atom2 nbor
-                !  1 2 3   A : 1 B : 2  C : 3 -> found B-A-C
-                !                       C : 3 -> found A-B-C
-                !          A : 1 C : 3  B : 2 -> B < C (2 < 3) so ignored
-                !                       B : 2 -> found A-C-B
-                !          B : 2 C : 3  A : 1 -> A < B (1 < 2) so ignored
-                !                       A : 1 -> A < C (1 < 3) so ignored
-
-                if(many_bodies_found)then
-
-                   !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
-                   ! apply 3-body bond order factors !
-                   !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
-
-                   ! neighbors of atom2
-                   nbors2 = atom2%neighbor_list                   
-                   bond_indices2 => atom2%bond_indices
-
-                   ! First we try to find ordered triplets atom2 -- atom1 -- atom3
-                   ! Therefore we need separations a2--a1 and a1--a3.
-                   separations(1:3,1) = -separations(1:3,1)
-
-                   ! loop over neighbors of atom 1
-                   do l = 1, nbors1%n_neighbors
-                      index3 = nbors1%neighbors(l)
-
-                      ! the condition for finding each triplet once is such that
-                      ! index 3 must be higher than the index of the atom whose
-                      ! neighbors are NOT currently searched
-                      ! For the offset check, we want atom2->atom3 offset, which is
-                      ! (atom1->atom3) - (atom1->atom2), the latter being stored in offset
-                      if(pick(index2,index3,nbors1%pbc_offsets(1:3,l)-offset))then
-
-                         ! third atom of the triplet
-                         atom3 = atoms(index3)
-                         ! atom3 is new so we don't know the separation from atom1
-                         separation3_unknown = .true.
-                         ! The list of atoms is passed to bond factor evaluation routine
-                         ! for further filtering.
-                         ! This is triplet atom2 - atom1 - atom3, since we loop over
-                         ! neighbors of atom1.
-                         atom_list = (/ atom2, atom1, atom3 /)
-
-                         ! search for the first bond params containing the parameters for atom1-atom2
-                         do k1 = 1, size(bond_indices)
+    ! loop over neighbors
+    do j = 1, neighbors_within(nbors1,atom1%max_bond_radius)
+
+       ! neighboring atom
+       index2 = nbors1%neighbors(j)
+       offset(1:3) = nbors1%pbc_offsets(1:3,j)
+
+       ! Since we loop over the neighbors of all atoms, we will find the pair
+       ! atom1-atom2 = atom2-atom1 twice.
+       ! To prevent the double counting, we filter by index2 > index1.
+       if(pick(index1,index2,offset))then
+
+          atom2 = atoms(index2)
+          atom_list(1) = atom1
+          atom_list(2) = atom2
+
+          ! calculate atom1-atom2 separation vector
+          ! and distance
+          call separation_vector(atom1%position, &
+               atom2%position, &
+               nbors1%pbc_offsets(1:3,j), &
+               core_cell_of_atom(atom1%index), &
+               separations(1:3,1)) ! in Geometry.f90
+          distances(1) = .norm.(separations(1:3,1))
+          if(distances(1) == 0.d0)then
+             directions(1:3,1) = (/ 0.d0, 0.d0, 0.d0 /)
+          else
+             directions(1:3,1) = separations(1:3,1) / distances(1)
+          end if
+
+          many_bodies_found = .false.
+
+          !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
+          ! apply 2-body bond order factors !
+          !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
+
+          if(distances(1) < atom1%max_bond_radius)then
+
+             ! loop over bond order factors affecting atom1
+             do k1 = 1, size(bond_indices)
+                
+                bond_params(1) = bond_factors(bond_indices(k1))
+                
+                ! filter the bond indices before applying by checking:
+                ! number of targets,
+                ! is atom2 affected by the factor,
+                ! is the factor in the correct group
+                if( bond_params(1)%n_level == 1)then
+                   call bond_order_factor_is_in_group(bond_params(1),group_index,is_in_group) ! in Potentials.f90
+                   if( is_in_group .and. bond_params(1)%cutoff > distances(1) )then
+                      call bond_order_factor_affects_atom(bond_params(1),atom2,is_active,2) ! in Potentials.f90
+                      if( is_active )then 
+                         call get_number_of_targets_of_bond_order_factor_index(bond_params(1)%type_index,&
+                              n_targets) ! in Potentials.f90
+                         if( n_targets == 2 )then
                             
-                            bond_params(1) = bond_factors(bond_indices(k1))
+                            ! evaluate the atom1-atom2 term in the bond order factor sum
+                            call evaluate_bond_order_factor(2,separations(1:3,1),&
+                                 distances(1),&
+                                 bond_params(1),&
+                                 tmp_factor(1:2),&
+                                 atom_list(1:2)) ! in Potentials.f90
+                            
+                            sums(index1) = sums(index1) + tmp_factor(1)
+                            sums(index2) = sums(index2) + tmp_factor(2)
                             
-                            ! filter the parameters by:
-                            ! number of targets, atom2 and atom3 being targets, group index                   
-                            call bond_order_factor_is_in_group(bond_params(1),&
-                                 group_index,is_in_group) ! in Potentials.f90
+                         else if( n_targets > 2 )then
                             
-                            if( is_in_group .and. bond_params(1)%n_level == 1 )then
+                            ! If the number of targets is greater than 2,
+                            ! we have found a many-body bond order factor.
+                            ! Make a note that we must also evaluate the many-body factors.
+                            many_bodies_found = .true.
+                            
+                         end if ! n_targets == 2
+                      end if ! is_active
+                   end if ! is_in_group
+                end if ! n_level == 1
+
+             end do ! k1 = 1, size(bond_indices)
+          end if ! distance < max_cut
+
+          ! Only do the 3-body loop if we found many-body factors 
+          ! during 2-body evaluation.
+          ! 
+          ! In the 3-body loop, we search the neighbors of both atom1
+          ! and atom2 to find the triplets 
+          ! atom1-atom2-atom3 and
+          ! atom2-atom1-atom3
+          ! These are considered to be different, since the middle atom of
+          ! the triplet is different (atom2 vs. atom1).
+          !
+          ! We loop over all atoms to get atom1, 
+          ! then over the neighbors of the atom1 to get atom2,
+          ! then again over the neighbors of both atom1 and atom2 to get atom3.
+          ! We want to find every triplet A-B-C, B-A-C, A-C-B exactly once filtering by the
+          ! ordering of the indices of the atoms.
+          ! Triplets A-B-C are considered equal to C-B-A and should be only found once.
+          !
+          ! Consider the indices A: 1, B: 2, C: 3. For other orderings, we can just
+          ! permutate the names A, B and C so this is not affecting the generality
+          ! of the argument.
+          !
+          ! We already filter by index1 < index2 when searching for atom2.
+          ! Therefore the possible ways to get atom1 and atom2 for these orderings are:
+          !
+          !  A B C   atom1 atom2  or  atom1 atom2  or  atom1 atom2 
+          !  1 2 3   A : 1 B : 2      A : 1 C : 3      B : 2 C : 3
+          !
+          ! If we filter atom3 by index3 > index2 when searching atom1 neighbors
+          ! and index3 > index1 when searching atom2 neighbors (i.e., index3
+          ! greater than the index of the atom whose neighbors are not searched),
+          ! we get:
+          !
+          !  A B C   atom1 atom2  atom3 as atom1 nbor / atom2 nbor
+          !  1 2 3   A : 1 B : 2  C : 3 -> found B-A-C
+          !                       C : 3 -> found A-B-C
+          !          A : 1 C : 3  B : 2 -> B < C (2 < 3) so ignored
+          !                       B : 2 -> found A-C-B
+          !          B : 2 C : 3  A : 1 -> A < B (1 < 2) so ignored
+          !                       A : 1 -> A < C (1 < 3) so ignored
+
+          if(many_bodies_found)then
+
+             !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
+             ! apply 3-body bond order factors !
+             !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
+
+             ! neighbors of atom2
+             nbors2 = atom2%neighbor_list                   
+             bond_indices2 => atom2%bond_indices
+
+             ! First we try to find ordered triplets atom2 -- atom1 -- atom3
+             ! Therefore we need separations a2--a1 and a1--a3.
+             separations(1:3,1) = -separations(1:3,1)
+
+             ! loop over neighbors of atom 1
+             do l = 1, neighbors_within(nbors1,atom1%max_bond_radius)
+                index3 = nbors1%neighbors(l)
+
+                ! the condition for finding each triplet once is such that
+                ! index 3 must be higher than the index of the atom whose
+                ! neighbors are NOT currently searched
+                ! For the offset check, we want atom2->atom3 offset, which is
+                ! (atom1->atom3) - (atom1->atom2), the latter being stored in offset
+                if(pick(index2,index3,nbors1%pbc_offsets(1:3,l)-offset))then
+
+                   ! third atom of the triplet
+                   atom3 = atoms(index3)
+                   ! atom3 is new so we don't know the separation from atom1
+                   separation3_unknown = .true.
+                   ! The list of atoms is passed to bond factor evaluation routine
+                   ! for further filtering.
+                   ! This is triplet atom2 - atom1 - atom3, since we loop over
+                   ! neighbors of atom1.
+                   atom_list = (/ atom2, atom1, atom3 /)
+
+                   ! search for the first bond params containing the parameters for atom1-atom2
+                   do k1 = 1, size(bond_indices)
+                      
+                      bond_params(1) = bond_factors(bond_indices(k1))
+                      
+                      ! filter the parameters by:
+                      ! number of targets, atom2 and atom3 being targets, group index                   
+                      call bond_order_factor_is_in_group(bond_params(1),&
+                           group_index,is_in_group) ! in Potentials.f90
+                      
+                      if( is_in_group .and. bond_params(1)%n_level == 1 )then
+                         call bond_order_factor_affects_atom(bond_params(1),&
+                              atom2,is_active,2) ! in Potentials.f90
+                         if( is_active )then
+                            call get_number_of_targets_of_bond_order_factor_index(bond_params(1)%type_index,&
+                                 n_targets) ! in Potentials.f90
+                            if( n_targets == 3 )then
                                call bond_order_factor_affects_atom(bond_params(1),&
-                                    atom2,is_active,2) ! in Potentials.f90
+                                    atom3,is_active,3) ! in Potentials.f90
                                if( is_active )then
-                                  call get_number_of_targets_of_bond_order_factor_index(bond_params(1)%type_index,&
-                                       n_targets) ! in Potentials.f90
-                                  if( n_targets == 3 )then
-                                     call bond_order_factor_affects_atom(bond_params(1),&
-                                          atom3,is_active,3) ! in Potentials.f90
-                                     if( is_active )then
-                                                  
-                         ! search for the second bond params containing the 
-                         ! parameters for atom1-atom3
-                         do k2 = 1, size(bond_indices)
-
-                            bond_params(2) = bond_factors(bond_indices(k2))
-                            call bond_order_factor_is_in_group(bond_params(2),&
-                                 group_index,is_in_group) ! in Potentials.f90
-                            if( is_in_group .and. bond_params(2)%n_level == 1 )then 
+                                            
+                   ! search for the second bond params containing the 
+                   ! parameters for atom1-atom3
+                   do k2 = 1, size(bond_indices)
+
+                      bond_params(2) = bond_factors(bond_indices(k2))
+                      call bond_order_factor_is_in_group(bond_params(2),&
+                           group_index,is_in_group) ! in Potentials.f90
+                      if( is_in_group .and. bond_params(2)%n_level == 1 )then 
+                         call bond_order_factor_affects_atom(bond_params(2),&
+                              atom3,is_active,2) ! in Potentials.f90
+                         if( is_active )then
+                            call get_number_of_targets_of_bond_order_factor_index(&
+                                 bond_params(2)%type_index,&
+                                 n_targets) ! in Potentials.f90
+                            if( n_targets == 3 )then
                                call bond_order_factor_affects_atom(bond_params(2),&
-                                    atom3,is_active,2) ! in Potentials.f90
+                                    atom2,is_active,3) ! in Potentials.f90
                                if( is_active )then
-                                  call get_number_of_targets_of_bond_order_factor_index(&
-                                       bond_params(2)%type_index,&
-                                       n_targets) ! in Potentials.f90
-                                  if( n_targets == 3 )then
-                                     call bond_order_factor_affects_atom(bond_params(2),&
-                                          atom2,is_active,3) ! in Potentials.f90
-                                     if( is_active )then
-                                        
-                                        ! When we loop over the bond factors
-                                        ! we may need the atom1-atom3 distance
-                                        ! repeatedly. We only calculate it the first
-                                        ! time.
-                                        if( separation3_unknown )then
-                                           call separation_vector(atom1%position, &
-                                                atom3%position, &
-                                                nbors1%pbc_offsets(1:3,j), &
-                                                cell, &
-                                                separations(1:3,2)) ! in Geometry.f90
-                                           separation3_unknown = .false.
-                                           distances(2) = .norm.(separations(1:3,2))
-                                           if(distances(2) == 0.d0)then
-                                              directions(1:3,2) = (/ 0.d0, 0.d0, 0.d0 /)
-                                           else
-                                              directions(1:3,2) = separations(1:3,2) / distances(2)
-                                           end if
-                                        end if
-                                        
-                                        ! Evaluate the atom2-atom1-atom3 triplet contribution
-                                        ! in the bond order factor sum.
-                                        call evaluate_bond_order_factor(3,separations(1:3,1:2),&
-                                             distances(1:2),bond_params(1:2),tmp_factor(1:3),atom_list)
-                                        
-                                        bo_temp(index2) = bo_temp(index2) + tmp_factor(1)
-                                        bo_temp(index1) = bo_temp(index1) + tmp_factor(2)
-                                        bo_temp(index3) = bo_temp(index3) + tmp_factor(3)
-                                        
-                                     end if ! is_active
-                                  end if ! n_targets == 3
+                                  
+                                  ! When we loop over the bond factors
+                                  ! we may need the atom1-atom3 distance
+                                  ! repeatedly. We only calculate it the first
+                                  ! time.
+                                  if( separation3_unknown )then
+                                     call separation_vector(atom1%position, &
+                                          atom3%position, &
+                                          nbors1%pbc_offsets(1:3,j), &
+                                          core_cell_of_atom(atom1%index), &
+                                          separations(1:3,2)) ! in Geometry.f90
+                                     separation3_unknown = .false.
+                                     distances(2) = .norm.(separations(1:3,2))
+                                     if(distances(2) == 0.d0)then
+                                        directions(1:3,2) = (/ 0.d0, 0.d0, 0.d0 /)
+                                     else
+                                        directions(1:3,2) = separations(1:3,2) / distances(2)
+                                     end if
+                                  end if
+                                  
+                                  ! Evaluate the atom2-atom1-atom3 triplet contribution
+                                  ! in the bond order factor sum.
+                                  call evaluate_bond_order_factor(3,separations(1:3,1:2),&
+                                       distances(1:2),bond_params(1:2),tmp_factor(1:3),atom_list)
+                                  
+                                  sums(index2) = sums(index2) + tmp_factor(1)
+                                  sums(index1) = sums(index1) + tmp_factor(2)
+                                  sums(index3) = sums(index3) + tmp_factor(3)
+                                  
                                end if ! is_active
-                            end if ! is_in_group
-                         end do ! k2
-                         
-                                     end if ! is_active
-                                  end if ! n_targets == 3
+                            end if ! n_targets == 3
+                         end if ! is_active
+                      end if ! is_in_group
+                   end do ! k2
+                   
                                end if ! is_active
-                            end if ! is_in_group
-                         end do ! k1
+                            end if ! n_targets == 3
+                         end if ! is_active
+                      end if ! is_in_group
+                   end do ! k1
 
-                      end if ! index3 > index2
+                end if ! index3 > index2
 
-                   end do ! l = 1, nbors1%n_neighbors
+             end do ! l = 1, nbors1%n_neighbors
 
 
-                   ! Next we try to find ordered triplets atom1 -- atom2 -- atom3
-                   ! Therefore we need separations a2--a1 and a2--a3.
-                   separations(1:3,1) = -separations(1:3,1)
-                   directions(1:3,1) = -directions(1:3,1)
+             ! Next we try to find ordered triplets atom1 -- atom2 -- atom3
+             ! Therefore we need separations a2--a1 and a2--a3.
+             separations(1:3,1) = -separations(1:3,1)
+             directions(1:3,1) = -directions(1:3,1)
 
-                   ! loop over neighbors of atom 2
-                   do l = 1, nbors2%n_neighbors
-                      index3 = nbors2%neighbors(l)
+             ! loop over neighbors of atom 2
+             do l = 1, neighbors_within(nbors2,atom2%max_bond_radius)
+                index3 = nbors2%neighbors(l)
+                
+                ! the condition for finding each triplet once is such that
+                ! index 3 must be higher than the index of the atom whose
+                ! neighbors are NOT currently searched
+                ! For the offset check we need atom1->atom3 which equals
+                ! (atom1->atom2) + (atom2->atom3), the former being stored in offset
+                if(pick(index1,index3,nbors2%pbc_offsets(1:3,l)+offset))then
+
+                   ! Third atom of the triplet.
+                   atom3 = atoms(index3)
+                   separation3_unknown = .true.
+                   atom_list = (/ atom1, atom2, atom3 /)
+
+                   ! search for the first bond params containing the parameters for atom2-atom1
+                   do k1 = 1, size(bond_indices2)
+                   
+                      bond_params(1) = bond_factors(bond_indices2(k1))
                       
-                      ! the condition for finding each triplet once is such that
-                      ! index 3 must be higher than the index of the atom whose
-                      ! neighbors are NOT currently searched
-                      ! For the offset check we need atom1->atom3 which equals
-                      ! (atom1->atom2) + (atom2->atom3), the former being stored in offset
-                      if(pick(index1,index3,nbors2%pbc_offsets(1:3,l)+offset))then
-
-                         ! Third atom of the triplet.
-                         atom3 = atoms(index3)
-                         separation3_unknown = .true.
-                         atom_list = (/ atom1, atom2, atom3 /)
-
-                         ! search for the first bond params containing the parameters for atom2-atom1
-                         do k1 = 1, size(bond_indices2)
-                         
-                            bond_params(1) = bond_factors(bond_indices2(k1))
-                            
-                            ! filter the parameters by:
-                            ! number of targets, atom2 and atom3 being targets, group index
-                            call bond_order_factor_is_in_group(bond_params(1),&
-                                 group_index,is_in_group) ! in Potentials.f90                         
-                            if( is_in_group .and. bond_params(1)%n_level == 1 )then 
+                      ! filter the parameters by:
+                      ! number of targets, atom2 and atom3 being targets, group index
+                      call bond_order_factor_is_in_group(bond_params(1),&
+                           group_index,is_in_group) ! in Potentials.f90                         
+                      if( is_in_group .and. bond_params(1)%n_level == 1 )then 
+                         call bond_order_factor_affects_atom(bond_params(1),&
+                              atom1,is_active,2) ! in Potentials.f90
+                         if( is_active )then 
+                            call get_number_of_targets_of_bond_order_factor_index(&
+                                 bond_params(1)%type_index,&
+                                 n_targets) ! in Potentials.f90
+                            if( n_targets == 3 )then
                                call bond_order_factor_affects_atom(bond_params(1),&
-                                    atom1,is_active,2) ! in Potentials.f90
-                               if( is_active )then 
-                                  call get_number_of_targets_of_bond_order_factor_index(&
-                                       bond_params(1)%type_index,&
-                                       n_targets) ! in Potentials.f90
-                                  if( n_targets == 3 )then
-                                     call bond_order_factor_affects_atom(bond_params(1),&
-                                          atom3,is_active,3) ! in Potentials.f90                            
-                                     if( is_active )then
-                               
-                         ! search for the second bond params containing the parameters for atom2-atom3
-                         do k2 = 1, size(bond_indices2)
+                                    atom3,is_active,3) ! in Potentials.f90                            
+                               if( is_active )then
                          
-                            bond_params(2) = bond_factors(bond_indices2(k2))
-                            call bond_order_factor_is_in_group(bond_params(2),&
-                                 group_index,is_in_group) ! in Potentials.f90                         
-                            if( is_in_group .and. bond_params(2)%n_level == 1 )then 
+                   ! search for the second bond params containing the parameters for atom2-atom3
+                   do k2 = 1, size(bond_indices2)
+                   
+                      bond_params(2) = bond_factors(bond_indices2(k2))
+                      call bond_order_factor_is_in_group(bond_params(2),&
+                           group_index,is_in_group) ! in Potentials.f90                         
+                      if( is_in_group .and. bond_params(2)%n_level == 1 )then 
+                         call bond_order_factor_affects_atom(bond_params(2),&
+                              atom3,is_active,2) ! in Potentials.f90
+                         if( is_active )then 
+                            call get_number_of_targets_of_bond_order_factor_index(&
+                                 bond_params(2)%type_index,&
+                                 n_targets) ! in Potentials.f90
+                            if( n_targets == 3 )then
                                call bond_order_factor_affects_atom(bond_params(2),&
-                                    atom3,is_active,2) ! in Potentials.f90
-                               if( is_active )then 
-                                  call get_number_of_targets_of_bond_order_factor_index(&
-                                       bond_params(2)%type_index,&
-                                       n_targets) ! in Potentials.f90
-                                  if( n_targets == 3 )then
-                                     call bond_order_factor_affects_atom(bond_params(2),&
-                                          atom1,is_active,3) ! in Potentials.f90
-                                     if( is_active )then
-
-                                        if( separation3_unknown )then
-                                           call separation_vector(atom2%position, &
-                                                atom3%position, &
-                                                nbors2%pbc_offsets(1:3,l), &
-                                                cell, &
-                                                separations(1:3,2))  ! in Geometry.f90
-                                           separation3_unknown = .false.
-                                           distances(2) = .norm.(separations(1:3,2))
-                                           if(distances(2) == 0.d0)then
-                                              directions(1:3,2) = (/ 0.d0, 0.d0, 0.d0 /)
-                                           else
-                                              directions(1:3,2) = separations(1:3,2) / distances(2)
-                                           end if
-                                        end if
-                                        
-                                        ! Evaluate the atom1-atom2-atom3 triplet contribution
-                                        ! in the bond order factor sum.
-                                        call evaluate_bond_order_factor(3,separations(1:3,1:2),&
-                                             distances(1:2),bond_params(1:2),tmp_factor(1:3),atom_list)
-
-                                        bo_temp(index1) = bo_temp(index1) + tmp_factor(1)
-                                        bo_temp(index2) = bo_temp(index2) + tmp_factor(2)
-                                        bo_temp(index3) = bo_temp(index3) + tmp_factor(3)
-                                     
-                                     end if ! is_active
-                                  end if ! n_targets == 3
+                                    atom1,is_active,3) ! in Potentials.f90
+                               if( is_active )then
+
+                                  if( separation3_unknown )then
+                                     call separation_vector(atom2%position, &
+                                          atom3%position, &
+                                          nbors2%pbc_offsets(1:3,l), &
+                                          core_cell_of_atom(atom2%index), &
+                                          separations(1:3,2))  ! in Geometry.f90
+                                     separation3_unknown = .false.
+                                     distances(2) = .norm.(separations(1:3,2))
+                                     if(distances(2) == 0.d0)then
+                                        directions(1:3,2) = (/ 0.d0, 0.d0, 0.d0 /)
+                                     else
+                                        directions(1:3,2) = separations(1:3,2) / distances(2)
+                                     end if
+                                  end if
+                                  
+                                  ! Evaluate the atom1-atom2-atom3 triplet contribution
+                                  ! in the bond order factor sum.
+                                  call evaluate_bond_order_factor(3,separations(1:3,1:2),&
+                                       distances(1:2),bond_params(1:2),tmp_factor(1:3),atom_list)
+
+                                  sums(index1) = sums(index1) + tmp_factor(1)
+                                  sums(index2) = sums(index2) + tmp_factor(2)
+                                  sums(index3) = sums(index3) + tmp_factor(3)
+                               
                                end if ! is_active
-                            end if ! is_in_group
-                         end do ! k2
-                         
-                                     end if ! is_active
-                                  end if ! n_targets == 3
+                            end if ! n_targets == 3
+                         end if ! is_active
+                      end if ! is_in_group
+                   end do ! k2
+                   
                                end if ! is_active
-                            end if ! is_in_group
-                         end do ! k1
-
-                      end if ! index3 > index2
-
-                   end do ! l = 1, nbors2%n_neighbors
-
-                end if ! many_bodies_found
+                            end if ! n_targets == 3
+                         end if ! is_active
+                      end if ! is_in_group
+                   end do ! k1
 
-             end if ! index2 > index1
-          end do ! j = 1, nbors1%n_neighbors
+                end if ! index3 > index2
 
-       end if ! is_my_atom
+             end do ! l = 1, nbors2%n_neighbors
 
-    end do ! index1 = 1, size(atoms) 
+          end if ! many_bodies_found
 
-#ifdef MPI
-    ! sum the contributions from all the processors
-    call mpi_allreduce(bo_temp,total_bond_orders,size(total_bond_orders),mpi_double_precision,&
-         mpi_sum,mpi_comm_world,mpistat)
-#else
-    total_bond_orders = bo_temp
-#endif
+       end if ! index2 > index1
+    end do ! j = 1, nbors1%n_neighbors
 
-  end subroutine core_calculate_bond_order_factors
+  end subroutine core_add_bond_order_sums_of_atom
 
 
 
@@ -2484,7 +3191,7 @@ contains
 
 
     ! loop over neighbors of atom 1
-    do j = 1, nbors1%n_neighbors
+    do j = 1, neighbors_within(nbors1,atom1%max_bond_radius)
        
        ! neighboring atom
        index3 = nbors1%neighbors(j)
@@ -2498,7 +3205,7 @@ contains
        call separation_vector(atom1%position, &
             atom3%position, &
             offset(1:3), &
-            cell, &
+            core_cell_of_atom(atom1%index), &
             separations(1:3,2)) ! in Geometry.f90
        distances(2) = .norm.(separations(1:3,2))
        if(distances(2) == 0.d0)then
@@ -2562,7 +3269,7 @@ contains
     directions(1:3,1) = -directions(1:3,1)
 
     ! loop over neighbors of atom 2
-    do j = 1, nbors2%n_neighbors
+    do j = 1, neighbors_within(nbors2,atom2%max_bond_radius)
        
        ! neighboring atom
        index3 = nbors2%neighbors(j)
@@ -2577,7 +3284,7 @@ contains
        call separation_vector(atom2%position, &
             atom3%position, &
             offset(1:3), &
-            cell, &
+            core_cell_of_atom(atom2%index), &
             separations(1:3,2)) ! in Geometry.f90
        distances(2) = .norm.(separations(1:3,2))
        if(distances(2) == 0.d0)then
@@ -2672,52 +3379,16 @@ contains
     implicit none
     integer, intent(in) :: group_index
     double precision, intent(inout) :: total_bond_orders(:)
-    integer :: index1, index2
+    integer :: index1
     double precision, intent(in) :: raw_sums(:)
-    type(atom) :: atom1
-    type(bond_order_parameters) :: bond_params
-    integer, pointer :: bond_indices(:)
-    integer :: post_process
 
     ! loop over all atoms
     do index1 = 1, size(atoms)
        
        ! in MPI, only consider the atoms allocated to this particular cpu
        if(is_my_atom(index1))then
-
-          ! target atom
-          atom1 = atoms(index1)
-          bond_indices => atom1%bond_indices
-
-          ! Check all the bond factors that affect the atom and see
-          ! if any of them require post processing.
-          ! If such a factor is found, the corresponding parameters
-          ! are saved to be used for the post processing.
-          ! Note that only one set of post processing parameters will
-          ! be used: the first found. This is because there may well
-          ! be several factors acting on the same type of atom and
-          ! we do not want to apply the post processing several times.
-          post_process = -1
-          do index2 = 1, size(bond_indices)
-             bond_params = bond_factors(bond_indices(index2))
-             if( bond_params%includes_post_processing .and. bond_params%n_level == 1 )then
-                if( bond_params%original_elements(1) == atom1%element )then
-                    if( bond_params%group_index == group_index)then
-                       post_process = bond_indices(index2)
-                       exit
-                    end if
-                end if
-             end if
-          end do
-
-          if( post_process > 0 )then
-             call post_process_bond_order_factor(raw_sums(index1),&
-                  bond_factors( post_process ), &
-                  bo_temp(index1) ) ! in Potentials.f90
-          else
-             bo_temp(index1) = raw_sums(index1)
-          end if
-
+          call core_post_process_bond_order_factor_of_atom(group_index,index1,&
+               raw_sums(index1),bo_temp(index1))
        else
           bo_temp(index1) = 0.d0
        end if
@@ -2735,6 +3406,63 @@ contains
   end subroutine core_post_process_bond_order_factors
 
 
+! !!!: core_post_process_bond_order_factor_of_atom
+
+  ! Applies the per-atom scaling function to the bond order sum of 
+  ! the given atom, as :func:`core_post_process_bond_order_factors`
+  ! does for all atoms.
+  !
+  ! *group_index an index denoting the potential to which the factor is connected
+  ! *index1 index of the atom
+  ! *raw_sum precalculated bond order sum of the atom
+  ! *total_bond_order the calculated bond order factor of the atom
+  subroutine core_post_process_bond_order_factor_of_atom(group_index,index1,raw_sum,total_bond_order)
+    implicit none
+    integer, intent(in) :: group_index, index1
+    double precision, intent(in) :: raw_sum
+    double precision, intent(out) :: total_bond_order
+    integer :: index2
+    type(atom) :: atom1
+    type(bond_order_parameters) :: bond_params
+    integer, pointer :: bond_indices(:)
+    integer :: post_process
+
+    ! target atom
+    atom1 = atoms(index1)
+    bond_indices => atom1%bond_indices
+
+    ! Check all the bond factors that affect the atom and see
+    ! if any of them require post processing.
+    ! If such a factor is found, the corresponding parameters
+    ! are saved to be used for the post processing.
+    ! Note that only one set of post processing parameters will
+    ! be used: the first found. This is because there may well
+    ! be several factors acting on the same type of atom and
+    ! we do not want to apply the post processing several times.
+    post_process = -1
+    do index2 = 1, size(bond_indices)
+       bond_params = bond_factors(bond_indices(index2))
+       if( bond_params%includes_post_processing .and. bond_params%n_level == 1 )then
+          if( bond_params%original_elements(1) == atom1%element )then
+             if( bond_params%group_index == group_index)then
+                post_process = bond_indices(index2)
+                exit
+             end if
+          end if
+       end if
+    end do
+
+    if( post_process > 0 )then
+       call post_process_bond_order_factor(raw_sum,&
+            bond_factors( post_process ), &
+            total_bond_order ) ! in Potentials.f90
+    else
+       total_bond_order = raw_sum
+    end if
+
+  end subroutine core_post_process_bond_order_factor_of_atom
+
+
 
 
 
@@ -3252,47 +3980,36 @@ contains
     integer, intent(in) :: calculation_type
     double precision, intent(inout) :: total_energy, total_forces(:,:), &
          total_enegs(:), total_stress(6)
-    integer :: j, k, l, m, n_targets, index1, index2, index3, index4, n_manybody
-    double precision,save :: energy,  &
-         stress(6), &
-         separations(3,3), distances(3), directions(3,3), &
-         stopwatch_0, stopwatch_1
-    type(atom) :: atom1, atom2, atom3, atom4
-    type(atom), save :: atom_list(4)
-    type(neighbor_list) :: nbors1, nbors2, nbors3
-    integer, pointer :: interaction_indices(:), manybody_indices(:)
-    logical :: is_active, many_bodies_found
-    double precision :: max_cutoff, sigma, inv_eps_4pi, inv_sigma_sqrt_2, charge1, charge2, &
-         inv_eps_2v, inv_dist, inv_sigma_sqrt_2pi, &
-         inv_sigma_sqrt_2perpi, inv_sigma_sq_2, &
-         tmp_forces(3), tmp_eneg, &
-         t00, t0, t1, t2, t3, t4, t5, t6, t7, t8, t9, ta, tb, tc, td, te, tf
-    integer, save :: reci_length(3), offset(3), tripleoffset(3), quadoffset(3), n_atoms
+    integer :: index1, n_atoms, thread_index, n_systems, n_collected
+    double precision :: energy, stress(6), stopwatch_0, &
+         t00, t0, t1, t2, t5, t6, t8, t9, ta, tb
+    integer, pointer :: manybody_indices(:), thread_manybody_indices(:)
+    double precision, allocatable :: thread_energy(:), thread_forces(:,:,:), &
+         thread_enegs(:,:), thread_stress(:,:), system_sums(:,:), thread_system_sums(:,:,:), &
+         total_system_sums(:,:), atom_sums(:,:), thread_atom_sums(:,:,:), total_atom_sums(:,:)
+    logical :: use_threads
 
     t00 = 0.0
     t0 = 0.0
     t1 = 0.0
     t2 = 0.0
-    t3 = 0.0
-    t4 = 0.0
     t5 = 0.0
     t6 = 0.0
-    t7 = 0.0
     t8 = 0.0
     t9 = 0.0
     ta = 0.0
     tb = 0.0
-    tc = 0.0
-    td = 0.0
-    te = 0.0
-    tf = 0.0
 
     nullify(manybody_indices)
     allocate(manybody_indices(n_interactions))
-    n_manybody = 0
 
     n_atoms = size(atoms)
 
+    ! The bond order factors are stored in module arrays during the
+    ! evaluation, so potentials with bond order factors are always evaluated
+    ! in a single thread.
+    use_threads = (n_threads > 1 .and. n_bond_factors == 0)
+
     energy = 0.d0
     total_energy = 0.d0
 
@@ -3305,13 +4022,24 @@ contains
     stress = 0.d0
     total_stress = 0.d0
 
-    inv_eps_4pi = 1.d0 / (4.d0 * pi * ewald_epsilon)
-    inv_eps_2v = 1.d0 / (2.d0 * cell%volume * ewald_epsilon)
-    inv_sigma_sqrt_2 = 1.d0 / (sqrt(2.d0) * ewald_sigma)
-    inv_sigma_sqrt_2pi = 1.d0 / (sqrt(2.d0 * pi) * ewald_sigma)
-    inv_sigma_sqrt_2 = 1.d0 / (sqrt(2.d0) * ewald_sigma)
-    inv_sigma_sq_2 = inv_sigma_sqrt_2*inv_sigma_sqrt_2
-    inv_sigma_sqrt_2perpi = 2.d0 * inv_sigma_sqrt_2pi
+    ! For packed systems, the energy and stress are also summed for each
+    ! system separately: system_sums(1,i) is the energy and system_sums(2:7,i)
+    ! the stress of system i.
+    n_systems = 0
+    if(systems_packed)then
+       n_systems = size(system_cells)
+    end if
+    allocate(system_sums(7,n_systems))
+    system_sums = 0.d0
+
+    ! If requested, the energy and virial of each atom are collected in the
+    ! same way in atom_sums. Otherwise the array is left empty.
+    n_collected = 0
+    if(evaluate_atom_contributions)then
+       n_collected = n_atoms
+    end if
+    allocate(atom_sums(7,n_collected))
+    atom_sums = 0.d0
 
     ! For MPI load balancing, the execution time of each cpu
     ! is recorded. After the forces have been calculated, the
@@ -3332,628 +4060,150 @@ contains
 
     call mpi_wall_clock(t0)
     t1 = t1+t0-t00
+    t00 = t0
 
     ! loop over atoms
-    do index1 = 1, n_atoms
-
-       ! in MPI, only consider the atoms allocated to this particular cpu
-       if(is_my_atom(index1))then
-
-          ! Bond order gradients are not stored since there are potentially
-          ! so many. Some most recent ones are saved, though.
-          ! At the start of the first atom loop, we clear the storage.
-          ! call core_empty_bond_order_gradient_storage()
+    if(use_threads)then
+
+       ! In threaded execution, the atoms are divided in contiguous blocks
+       ! between the threads and each thread accumulates its contributions
+       ! in its own buffers. The buffers are summed afterwards in the order of
+       ! the threads so that the result does not depend on thread timing.
+       allocate(thread_energy(0:n_threads-1))
+       allocate(thread_forces(3,n_atoms,0:n_threads-1))
+       allocate(thread_enegs(n_atoms,0:n_threads-1))
+       allocate(thread_stress(6,0:n_threads-1))
+       allocate(thread_system_sums(7,n_systems,0:n_threads-1))
+       allocate(thread_atom_sums(7,n_collected,0:n_threads-1))
+       thread_energy = 0.d0
+       thread_forces = 0.d0
+       thread_enegs = 0.d0
+       thread_stress = 0.d0
+       thread_system_sums = 0.d0
+       thread_atom_sums = 0.d0
+
+       !$omp parallel num_threads(n_threads) default(shared) &
+       !$omp private(index1, thread_index, thread_manybody_indices)
+       thread_index = 0
+       !$ thread_index = omp_get_thread_num()
+       nullify(thread_manybody_indices)
+       allocate(thread_manybody_indices(n_interactions))
+
+       !$omp do schedule(static)
+       do index1 = 1, n_atoms
+          ! in MPI, only consider the atoms allocated to this particular cpu
+          if(is_my_atom(index1))then
+             if(systems_packed)then
+                call core_evaluate_local_interactions_of_packed_atom(index1,calculation_type,&
+                     thread_energy(thread_index),&
+                     thread_forces(1:3,1:n_atoms,thread_index),&
+                     thread_enegs(1:n_atoms,thread_index),&
+                     thread_stress(1:6,thread_index),&
+                     thread_system_sums(1:7,1:n_systems,thread_index),&
+                     thread_atom_sums(1:7,1:n_collected,thread_index),&
+                     thread_manybody_indices)
+             else
+                call core_evaluate_local_interactions_of_atom(index1,calculation_type,&
+                     thread_energy(thread_index),&
+                     thread_forces(1:3,1:n_atoms,thread_index),&
+                     thread_enegs(1:n_atoms,thread_index),&
+                     thread_stress(1:6,thread_index),&
+                     thread_atom_sums(1:7,1:n_collected,thread_index),&
+                     thread_manybody_indices)
+             end if
+          end if
+       end do
+       !$omp end do
+
+       deallocate(thread_manybody_indices)
+       !$omp end parallel
+
+       do thread_index = 0, n_threads-1
+          energy = energy + thread_energy(thread_index)
+          temp_forces = temp_forces + thread_forces(1:3,1:n_atoms,thread_index)
+          temp_enegs = temp_enegs + thread_enegs(1:n_atoms,thread_index)
+          stress = stress + thread_stress(1:6,thread_index)
+          system_sums = system_sums + thread_system_sums(1:7,1:n_systems,thread_index)
+          atom_sums = atom_sums + thread_atom_sums(1:7,1:n_collected,thread_index)
+       end do
 
-          atom1 = atoms(index1)
-          nbors1 = atom1%neighbor_list
-          interaction_indices => atom1%potential_indices
+       deallocate(thread_energy)
+       deallocate(thread_forces)
+       deallocate(thread_enegs)
+       deallocate(thread_stress)
+       deallocate(thread_system_sums)
+       deallocate(thread_atom_sums)
 
-          !*********************!
-          ! 1-body interactions !
-          !*********************!
+    else
 
-          call mpi_wall_clock(t00)
-          call core_evaluate_local_singlet(index1, &
-               atom1,&
-               interaction_indices,&
-               calculation_type,energy,temp_forces,stress,temp_enegs)
-          call mpi_wall_clock(t0)
-          t2 = t2+t0-t00
+       do index1 = 1, n_atoms
+          ! in MPI, only consider the atoms allocated to this particular cpu
+          if(is_my_atom(index1))then
+             if(systems_packed)then
+                call core_evaluate_local_interactions_of_packed_atom(index1,calculation_type,&
+                     energy,temp_forces,temp_enegs,stress,system_sums,atom_sums,manybody_indices)
+             else
+                call core_evaluate_local_interactions_of_atom(index1,calculation_type,&
+                     energy,temp_forces,temp_enegs,stress,atom_sums,manybody_indices)
+             end if
+          end if
+       end do
 
-          ! loop over neighbors
-          do j = 1, nbors1%n_neighbors
+    end if
 
+    call mpi_wall_clock(t0)
+    t2 = t2+t0-t00
 
-             ! Note that we loop over the neighbors in the outer loop and
-             ! over the interactions in the inner loop. This is to avoid calculating
-             ! the interatomic distances repeatedly for multiple potentials affecting
-             ! the same pair of atoms.
+    ! Stop the load timer
+    call timer(stopwatch_0)
 
-             ! neighboring atom
-             index2 = nbors1%neighbors(j)
-             offset(1:3) = nbors1%pbc_offsets(1:3,j) ! offset atom1 -> atom2
-
-             ! Since we loop over the neighbors of all atoms, we will find the pair
-             ! atom1-atom2 = atom2-atom1 twice.
-             ! To prevent the double counting, we filter by index2 > index1.
-             if(pick(index1,index2,offset))then
-
-                call mpi_wall_clock(t00)
-                ! Empty bond gradient storage for atom2 slot (since we have a new atom2)
-                ! call core_empty_bond_order_gradient_storage(2)
-
-                call mpi_wall_clock(t0)
-                t7 = t7+t0-t00
-                
-                atom2 = atoms(index2)
-                atom_list(1) = atom1
-                atom_list(2) = atom2
-                
-                call mpi_wall_clock(t00)
-                ! calculate atom1-atom2 separation vector
-                ! and distance
-                call separation_vector(atom1%position, &
-                     atom2%position, &
-                     nbors1%pbc_offsets(1:3,j), &
-                     cell, &
-                     separations(1:3,1)) ! in Geometry.f90
-                distances(1) = .norm.(separations(1:3,1))
-                if(distances(1) == 0.d0)then
-                   directions(1:3,1) = (/ 0.d0, 0.d0, 0.d0 /)
-                else
-                   directions(1:3,1) = separations(1:3,1) / distances(1)
-                end if
-                call mpi_wall_clock(t0)
-                t3 = t3+t0-t00
-
-                !*********************!
-                ! 2-body interactions !
-                !*********************!
-
-                t00 = t0
-
-                ! include the realspace part of ewald already here
-                if(evaluate_ewald)then
-                   if(distances(1) < ewald_cutoff)then
-                      charge1 = atom1%charge
-                      charge2 = atom2%charge
-
-                      select case(calculation_type)
-                      case(energy_evaluation_index)
-                         ! q_i q_j / r * erfc(r / (sqrt(2) sigma))
-                         energy = energy + charge1*charge2*(1.d0 - erf(distances(1)*inv_sigma_sqrt_2))/&
-                              (distances(1)) * inv_eps_4pi
-                      case(force_evaluation_index)
-                         ! q_i q_j * 
-                         ! ( erfc(r/(sigma*sqrt(2)))/r^2 + 
-                         ! 1/sigma sqrt(2/pi) exp(-r^2/(2 sigma^2))/r ) \hat{r} 
-                         inv_dist = 1/distances(1)
-                         tmp_forces =  -inv_eps_4pi * charge1*charge2 * ( &
-                              ( 1 - erf(distances(1)*inv_sigma_sqrt_2) ) * inv_dist*inv_dist + &
-                              inv_sigma_sqrt_2perpi * exp( -distances(1)*distances(1)*inv_sigma_sq_2 ) * inv_dist  ) * &
-                              separations(1:3,1) * inv_dist
-                         temp_forces(1:3,index1) = temp_forces(1:3,index1) + tmp_forces
-                         temp_forces(1:3,index2) = temp_forces(1:3,index2) - tmp_forces
-
-                         !***************!
-                         ! stress tensor !
-                         !***************!
-
-                         ! s_xx, s_yy, s_zz, s_yz, s_xz, s_xy:
-                         stress(1) = stress(1) - separations(1,1) * tmp_forces(1)
-                         stress(2) = stress(2) - separations(2,1) * tmp_forces(2)
-                         stress(3) = stress(3) - separations(3,1) * tmp_forces(3)
-                         stress(4) = stress(4) - separations(2,1) * tmp_forces(3)
-                         stress(5) = stress(5) - separations(1,1) * tmp_forces(3)
-                         stress(6) = stress(6) - separations(1,1) * tmp_forces(2)
-
-                      case(electronegativity_evaluation_index)
-
-                         ! q_j / r * erfc(r / (sqrt(2) sigma))
-                         tmp_eneg = -inv_eps_4pi/distances(1)*(1.d0 - erf(distances(1)*inv_sigma_sqrt_2))
-                         
-                         temp_enegs(index1) = temp_enegs(index1) + charge2*tmp_eneg
-                         temp_enegs(index2) = temp_enegs(index2) + charge1*tmp_eneg
-
-                      end select
-                   end if
-                end if
-
-                if(distances(1) < atom1%max_potential_radius)then
-                   ! differentiate between energy, force, and electronegativity evaluation
-                   select case(calculation_type)
-                   case(energy_evaluation_index)
-                      call core_evaluate_local_doublet_energy_B(atom_list(1:2), &
-                           index1, index2, &
-                           2, & ! test for atom2, since interaction indices filters for atom1 already
-                           interaction_indices, &
-                           separations(1:3,1), directions(1:3,1), distances(1), &
-                           energy, &
-                           many_bodies_found, &
-                           manybody_indices, &
-                           n_manybody )
-                   case(force_evaluation_index)
-                      call core_evaluate_local_doublet_forces_B(atom_list(1:2), &
-                           index1, index2, &
-                           2, & ! test for atom2, since interaction indices filters for atom1 already
-                           interaction_indices, &
-                           separations(1:3,1), directions(1:3,1), distances(1), &
-                           temp_forces,stress, &
-                           many_bodies_found, &
-                           manybody_indices, &
-                           n_manybody )
-                   case(electronegativity_evaluation_index)
-                      call core_evaluate_local_doublet_electronegativities_B(atom_list(1:2), &
-                           index1, index2, &
-                           2, & ! test for atom2, since interaction indices filters for atom1 already
-                           interaction_indices, &
-                           separations(1:3,1), directions(1:3,1), distances(1), &
-                           temp_enegs, &
-                           many_bodies_found, &
-                           manybody_indices, &
-                           n_manybody )
-                   end select
-                end if
-                call mpi_wall_clock(t0)
-                t4 = t4+t0-t00
-
-                ! Only do the 3-body loop if we found many-body potentials 
-                ! during 2-body evaluation.
-                ! 
-                ! In the 3-body loop, we search the neighbors of both atom1
-                ! and atom2 to find the triplets 
-                ! atom1-atom2-atom3 and
-                ! atom2-atom1-atom3
-                ! These are considered to be different, since the middle atom of
-                ! the triplet is different (atom2 vs. atom1).
-                !
-                ! We loop over all atoms to get atom1, 
-                ! then over the neighbors of the atom1 to get atom2,
-                ! then again over the neighbors of both atom1 and atom2 to get atom3.
-                ! We want to find every triplet A-B-C, B-A-C, A-C-B exactly once filtering by the
-                ! ordering of the indices of the atoms.
-                ! Triplets A-B-C are considered equal to C-B-A and should be only found once.
-                !
-                ! Consider the indices A: 1, B: 2, C: 3. For other orderings, we can just
-                ! permutate the names A, B and C so this is not affecting the generality
-                ! of the argument.
-                !
-                ! We already filter by index1 < index2 when searching for atom2.
-                ! Therefore the possible ways to get atom1 and atom2 for these orderings are:
-                !
-                !  A B C   atom1 atom2  or  atom1 atom2  or  atom1 atom2 
-                !  1 2 3   A : 1 B : 2      A : 1 C : 3      B : 2 C : 3
-                !
-                ! If we filter atom3 by index3 > index2 when searching atom1 neighbors
-                ! and index3 > index1 when searching atom2 neighbors (i.e., index3
-                ! greater than the index of the atom whose neighbors are not searched),
-                ! we get:
-                !
-                !  A B C   atom1 atom2  atom3 as atom1 nbor / atom2 nbor
-                !  1 2 3   A : 1 B : 2  C : 3 -> found B-A-C
-                !                       C : 3 -> found A-B-C
-                !          A : 1 C : 3  B : 2 -> B < C (2 < 3) so ignored
-                !                       B : 2 -> found A-C-B
-                !          B : 2 C : 3  A : 1 -> A < B (1 < 2) so ignored
-                !                       A : 1 -> A < C (1 < 3) so ignored
-
-
-                call start_timer()
-                call mpi_wall_clock(tc)
-                t00 = tc
-
-                if(many_bodies_found)then
-
-                   many_bodies_found = .false.
-
-                   !*********************!
-                   ! 3-body interactions !
-                   !*********************!
-
-                   ! neighbors of atom2
-                   nbors2 = atom2%neighbor_list
-
-                   ! First we try to find ordered triplets atom2 -- atom1 -- atom3
-                   ! Therefore we need separations a2--a1 and a1--a3.
-                   separations(1:3,1) = -separations(1:3,1)
-                   directions(1:3,1) = -directions(1:3,1)
-
-                   ! loop over neighbors atom 1
-                   do l = 1, nbors1%n_neighbors
-                      index3 = nbors1%neighbors(l)
-
-                      ! the condition for finding each triplet once is such that
-                      ! index 3 must be higher than the index of the atom whose
-                      ! neighbors are NOT currently searched
-                      ! For the offset check we need atom2->atom3 which equals
-                      ! (atom1->atom3) - (atom1->atom2), the latter being stored in offset
-                      tripleoffset = nbors1%pbc_offsets(1:3,l)-offset ! offset atom2 -> atom3
-                      if(pick(index2,index3,tripleoffset))then
-
-                         ! third atom of the triplet
-                         atom3 = atoms(index3)
-                         ! The list of atoms is passed to force evaluation routine
-                         ! for further filtering.
-                         ! This is triplet atom2 - atom1 - atom3, since we loop over
-                         ! neighbors of atom1.
-                         atom_list(1:3) = (/ atom2, atom1, atom3 /)
-
-                         ! Calculate the separations and distances between the particles
-                         ! starting from atom2: a2--a1, a1--a3
-                         ! (atom2 -- atom1 is already known though from 2-body calculation)
-                         call separation_vector(atom1%position, &
-                              atom3%position, &
-                              nbors1%pbc_offsets(1:3,l), &
-                              cell, &
-                              separations(1:3,2)) ! in Geometry.f90
-                         distances(2) = .norm.(separations(1:3,2))
-                         if(distances(2) == 0.d0)then
-                            directions(1:3,2) = (/ 0.d0, 0.d0, 0.d0 /)
-                         else
-                            directions(1:3,2) = separations(1:3,2) / distances(2)
-                         end if
-
-
-                         if(distances(2) < atom1%max_potential_radius)then
-                            call core_evaluate_local_triplet_B(atom_list(1:3), &
-                                 index2, index1, index3, & ! atom2 - atom1 - atom3
-                                 1, 3, & ! atom1 is 2nd in the triplet, so test for 1st and 3rd
-                                 !interaction_indices, &
-                                 separations(1:3,1:2), directions(1:3,1:2), distances(1:2), &
-                                 calculation_type, energy, temp_forces, temp_enegs, stress, &
-                                 many_bodies_found, &
-                                 manybody_indices, &
-                                 n_manybody )
-                         end if
-
-                         if(many_bodies_found)then
-
-                            many_bodies_found = .false.
-
-                            !*********************!
-                            ! 4-body interactions !
-                            !*********************!
-
-                            ! We search for atomic chain quadruplets A-B-C-D where the
-                            ! triplet A-B-C or B-C-D is the triplet considered above.
-                            ! Similarly to the triplets, the different quadruplets are found
-                            ! by searching the neighbors of the end atoms of the triplets.
-
-                            ! We have the triplet  atom2 -- atom1 -- atom3, so searching for neighbors of
-                            ! atom2 and atom3 gives quadruplets
-                            ! atom4 -- atom2 -- atom1 -- atom3 and
-                            ! atom2 -- atom1 -- atom3 -- atom4
-
-                            ! first, atom4 -- atom2 -- atom1 -- atom3:
-
-                            ! neighbors of atom3 (not yet needed, but later)
-                            nbors3 = atom3%neighbor_list
-
-                            ! we need separations a4-a2, a2-a1, a1-a3, the latter two are already
-                            ! known but in the wrong place
-                            separations(1:3,2:3) = separations(1:3,1:2)
-                            directions(1:3,2:3) = directions(1:3,1:2)
-                            distances(2:3) = distances(1:2)
-
-                            ! loop over neighbors atom 2
-                            do m = 1, nbors2%n_neighbors
-                               index4 = nbors2%neighbors(m)
-
-                               ! the condition for finding each triplet once is such that
-                               ! index 4 must be higher than the index of the atom whose
-                               ! neighbors are NOT currently searched
-                               ! For the offset check we need atom3->atom4 which equals
-                               ! (atom2->atom4) - (atom2->atom3), the latter being stored in tripleoffset
-                               quadoffset = nbors2%pbc_offsets(1:3,m)-tripleoffset ! offset atom3 -> atom4
-                               if(pick(index3,index4,quadoffset) .and. &
-                                  index4 /= index1)then
-
-                                  ! fourth atom of the quadruplet
-                                  atom4 = atoms(index4)
-                                  ! The list of atoms is passed to force evaluation routine
-                                  ! for further filtering.
-                                  atom_list(1:4) = (/ atom4, atom2, atom1, atom3 /)
-
-                                  call separation_vector(atom4%position, &
-                                       atom2%position, &
-                                       -nbors2%pbc_offsets(1:3,m), &
-                                       cell, &
-                                       separations(1:3,1)) ! in Geometry.f90
-                                  distances(1) = .norm.(separations(1:3,1))
-                                  if(distances(1) == 0.d0)then
-                                     directions(1:3,1) = (/ 0.d0, 0.d0, 0.d0 /)
-                                  else
-                                     directions(1:3,1) = separations(1:3,1) / distances(1)
-                                  end if
-
-                                  if(distances(1) < atom2%max_potential_radius)then
-                                     call core_evaluate_local_quadruplet_B(atom_list(1:4), &
-                                       index4, index2, index1, index3, & ! atom4 - atom2 - atom1 - atom3
-                                       1, 2, 4, & ! atom1 is 3rd in the quadruplet
-                                       !interaction_indices, &
-                                       separations(1:3,1:3), directions(1:3,1:3), distances(1:3), &
-                                       calculation_type, energy, temp_forces, temp_enegs, stress, &
-                                       many_bodies_found, &
-                                       manybody_indices, &
-                                       n_manybody )
-                                  end if
-
-                               end if ! index4 > index3
-                            end do ! m = 1, nbors2%n_neighbors
-
-                            ! move the a2-a1, a1-a3 separations back to their original place
-                            separations(1:3,1:2) = separations(1:3,2:3)
-                            directions(1:3,1:2) = directions(1:3,2:3)
-                            distances(1:2) = distances(2:3)
-
-
-
-                            ! second, atom2 -- atom1 -- atom3 -- atom4:
-
-                            ! we need separations a2-a1, a1-a3, a3-a4, the first two are already
-                            ! known and now in the right place as well
-
-                            ! loop over neighbors atom 3
-                            do m = 1, nbors3%n_neighbors
-                               index4 = nbors3%neighbors(m)
-
-                               ! the condition for finding each triplet once is such that
-                               ! index 4 must be higher than the index of the atom whose
-                               ! neighbors are NOT currently searched
-                               ! For the offset check we need atom2->atom4 which equals
-                               ! (atom3->atom4) + (atom2->atom3), the latter being stored in tripleoffset
-                               quadoffset = nbors3%pbc_offsets(1:3,m)+tripleoffset ! offset atom2 -> atom4
-                               if(pick(index2,index4,quadoffset) .and. &
-                                    index4 /= index1)then
-
-                                  ! fourth atom of the quadruplet
-                                  atom4 = atoms(index4)
-                                  ! The list of atoms is passed to force evaluation routine
-                                  ! for further filtering.
-                                  atom_list(1:4) = (/ atom2, atom1, atom3, atom4 /)
-
-                                  call separation_vector(atom3%position, &
-                                       atom4%position, &
-                                       nbors3%pbc_offsets(1:3,m), &
-                                       cell, &
-                                       separations(1:3,3)) ! in Geometry.f90
-                                  distances(3) = .norm.(separations(1:3,3))
-                                  if(distances(3) == 0.d0)then
-                                     directions(1:3,3) = (/ 0.d0, 0.d0, 0.d0 /)
-                                  else
-                                     directions(1:3,3) = separations(1:3,3) / distances(3)
-                                  end if
-
-                                  if(distances(3) < atom3%max_potential_radius)then
-                                     call core_evaluate_local_quadruplet_B(atom_list(1:4), &
-                                          index2, index1, index3, index4, & ! atom2 - atom1 - atom3 - atom4
-                                          1, 3, 4, & ! atom1 is 2nd in the quadruplet
-                                          !interaction_indices, &
-                                          separations(1:3,1:3), directions(1:3,1:3), distances(1:3), &
-                                          calculation_type, energy, temp_forces, temp_enegs, stress, &
-                                          many_bodies_found, &
-                                          manybody_indices, &
-                                          n_manybody )
-                                  end if
-
-                               end if ! index4 > index3
-                            end do ! m = 1, nbors3%n_neighbors
-
-                         end if ! many_bodies_found
-
-                      end if ! index3 > index2
-
-                   end do ! l = 1, nbors1%n_neighbors
-
-                   many_bodies_found = .false.
-
-                   ! Next we try to find ordered triplets atom1 -- atom2 -- atom3
-                   ! Therefore we need separations a1--a2 and a2--a3.
-                   separations(1:3,1) = -separations(1:3,1)
-                   directions(1:3,1) = -directions(1:3,1)
-
-                   ! loop over neighbors of atom 2
-                   do l = 1, nbors2%n_neighbors
-                      index3 = nbors2%neighbors(l)
-
-                      ! the condition for finding each triplet once is such that
-                      ! index 3 must be higher than the index of the atom whose
-                      ! neighbors are NOT currently searched
-                      ! For the offset check we need atom1->atom3 which equals
-                      ! (atom1->atom2) + (atom2->atom3), the former being stored in offset
-                      tripleoffset = nbors2%pbc_offsets(1:3,l)+offset ! offset atom1 -> atom3
-                      if(pick(index1,index3,tripleoffset))then
-
-                         ! third atom of the triplet
-                         atom3 = atoms(index3)
-                         ! The list of atoms is passed to force evaluation routine
-                         ! for further filtering.
-                         ! This is triplet atom1 - atom2 - atom3, since we loop over
-                         ! neighbors of atom2.
-                         atom_list(1:3) = (/ atom1, atom2, atom3 /)
-
-                         ! Calculate the separations and distances between the particles
-                         ! starting from atom1: a1--a2, a2--a3
-                         ! (atom1 -- atom2 is already known though from 2-body calculation)
-                         call separation_vector(atom2%position, &
-                              atom3%position, &
-                              nbors2%pbc_offsets(1:3,l), &
-                              cell, &
-                              separations(1:3,2)) ! in Geometry.f90
-                         distances(2) = .norm.(separations(1:3,2))
-                         if(distances(2) == 0.d0)then
-                            directions(1:3,2) = (/ 0.d0, 0.d0, 0.d0 /)
-                         else
-                            directions(1:3,2) = separations(1:3,2)/distances(2)
-                         end if
-
-                         if(distances(2) < atom2%max_potential_radius)then
-                            call core_evaluate_local_triplet_B(atom_list(1:3), &
-                                 index1, index2, index3, & ! atom1 - atom2 - atom3
-                                 2, 3, & ! atom1 is 1st in the triplet, so test for 2nd and 3rd
-                                 !interaction_indices, &
-                                 separations(1:3,1:2), directions(1:3,1:2), distances(1:2), &
-                                 calculation_type, energy, temp_forces, temp_enegs, stress, &
-                                 many_bodies_found, &
-                                 manybody_indices, &
-                                 n_manybody )
-                         end if
-
-                         if(many_bodies_found)then
-
-                            many_bodies_found = .false.
-
-                            !*********************!
-                            ! 4-body interactions !
-                            !*********************!
-
-                            ! We search for atomic chain quadruplets A-B-C-D where the
-                            ! triplet A-B-C or B-C-D is the triplet considered above.
-                            ! Similarly to the triplets, the different quadruplets are found
-                            ! by searching the neighbors of the end atoms of the triplets.
-
-                            ! We have the triplet  atom1 -- atom2 -- atom3, so searching for neighbors of
-                            ! atom1 and atom3 gives quadruplets
-                            ! atom4 -- atom1 -- atom2 -- atom3 and
-                            ! atom1 -- atom2 -- atom3 -- atom4
-
-                            ! first, atom4 -- atom1 -- atom2 -- atom3:
-
-                            ! neighbors of atom3
-                            nbors3 = atom3%neighbor_list
-
-                            ! we need separations a4-a1, a1-a2, a2-a3, the latter two are already
-                            ! known but in the wrong place
-                            separations(1:3,2:3) = separations(1:3,1:2)
-                            directions(1:3,2:3) = directions(1:3,1:2)
-                            distances(2:3) = distances(1:2)
-
-                            ! loop over neighbors atom 1
-                            do m = 1, nbors1%n_neighbors
-                               index4 = nbors1%neighbors(m)
-
-                               ! the condition for finding each triplet once is such that
-                               ! index 4 must be higher than the index of the atom whose
-                               ! neighbors are NOT currently searched
-                               ! For the offset check we need atom3->atom4 which equals
-                               ! (atom1->atom4) - (atom1->atom3), the latter being stored in tripleoffset
-                               quadoffset = nbors1%pbc_offsets(1:3,m)-tripleoffset ! offset atom3 -> atom4
-                               if(pick(index3,index4,quadoffset) .and. &
-                                    index4 /= index2)then
-
-                                  ! fourth atom of the quadruplet
-                                  atom4 = atoms(index4)
-                                  ! The list of atoms is passed to force evaluation routine
-                                  ! for further filtering.
-                                  atom_list(1:4) = (/ atom4, atom1, atom2, atom3 /)
-
-                                  call separation_vector(atom4%position, &
-                                       atom1%position, &
-                                       -nbors1%pbc_offsets(1:3,m), &
-                                       cell, &
-                                       separations(1:3,1)) ! in Geometry.f90
-                                  distances(1) = .norm.(separations(1:3,1))
-                                  if(distances(1) == 0.d0)then
-                                     directions(1:3,1) = (/ 0.d0, 0.d0, 0.d0 /)
-                                  else
-                                     directions(1:3,1) = separations(1:3,1) / distances(1)
-                                  end if
-
-
-                                  if(distances(1) < atom1%max_potential_radius)then
-                                     call core_evaluate_local_quadruplet_B(atom_list(1:4), &
-                                          index4, index1, index2, index3, & ! atom4 - atom1 - atom2 - atom3
-                                          1, 3, 4, & ! atom1 is 2nd in the quadruplet
-                                          !interaction_indices, &
-                                          separations(1:3,1:3), directions(1:3,1:3), distances(1:3), &
-                                          calculation_type, energy, temp_forces, temp_enegs, stress, &
-                                          many_bodies_found, &
-                                          manybody_indices, &
-                                          n_manybody )
-                                  end if
-
-                               end if ! index4 > index3
-                            end do ! m = 1, nbors2%n_neighbors
-
-                            ! move the a1-a2, a2-a3 separations back to their original place
-                            separations(1:3,1:2) = separations(1:3,2:3)
-                            directions(1:3,1:2) = directions(1:3,2:3)
-                            distances(1:2) = distances(2:3)
-
-
-
-                            ! second, atom1 -- atom2 -- atom3 -- atom4:
-
-                            ! we need separations a1-a2, a2-a3, a3-a4, the first two are already
-                            ! known and now in the right place as well
-
-                            ! loop over neighbors atom 3
-                            do m = 1, nbors3%n_neighbors
-                               index4 = nbors3%neighbors(m)
-
-                               ! the condition for finding each triplet once is such that
-                               ! index 4 must be higher than the index of the atom whose
-                               ! neighbors are NOT currently searched
-                               ! For the offset check we need atom1->atom4 which equals
-                               ! (atom3->atom4) + (atom1->atom3), the latter being stored in tripleoffset
-                               quadoffset = nbors3%pbc_offsets(1:3,m)+tripleoffset ! offset atom1 -> atom4
-                               if(pick(index1,index4,quadoffset) .and. &
-                                    index4 /= index2)then
-
-                                  ! fourth atom of the quadruplet
-                                  atom4 = atoms(index4)
-                                  ! The list of atoms is passed to force evaluation routine
-                                  ! for further filtering.
-                                  atom_list(1:4) = (/ atom1, atom2, atom3, atom4 /)
-
-                                  call separation_vector(atom3%position, &
-                                       atom4%position, &
-                                       nbors3%pbc_offsets(1:3,m), &
-                                       cell, &
-                                       separations(1:3,3)) ! in Geometry.f90
-                                  distances(3) = .norm.(separations(1:3,3))
-                                  if(distances(3) == 0.d0)then
-                                     directions(1:3,3) = (/ 0.d0, 0.d0, 0.d0 /)
-                                  else
-                                     directions(1:3,3) = separations(1:3,3) / distances(3)
-                                  end if
-
-
-                                  if(distances(3) < atom3%max_potential_radius)then
-                                     call core_evaluate_local_quadruplet_B(atom_list(1:4), &
-                                          index1, index2, index3, index4, & ! atom1 - atom2 - atom3 - atom4
-                                          2, 3, 4, & ! atom1 is 1st in the quadruplet
-                                          !interaction_indices, &
-                                          separations(1:3,1:3), directions(1:3,1:3), distances(1:3), &
-                                          calculation_type, energy, temp_forces, temp_enegs, stress, &
-                                          many_bodies_found, &
-                                          manybody_indices, &
-                                          n_manybody )
-                                  end if
-
-                               end if ! index4 > index3
-                            end do ! m = 1, nbors3%n_neighbors
-
-                         end if ! many_bodies_found
-
-                      end if ! index3 > index1
-
-                   end do ! l
-
-                end if ! many-bodies_found
-
-                call mpi_wall_clock(t0)
-                td = td+t0-t00
-
-             end if ! index2 > index1
-
-          end do ! j
-
-       end if ! is_my_atom
-    end do ! index1
+    if(systems_packed)then
+       allocate(total_system_sums(7,n_systems))
+#ifdef MPI
+       call mpi_allreduce(system_sums,total_system_sums,size(system_sums),mpi_double_precision,&
+            mpi_sum,mpi_comm_world,mpistat)
+#else
+       total_system_sums = system_sums
+#endif
+       select case(calculation_type)
+       case(energy_evaluation_index)
+          system_energies(1:n_systems) = total_system_sums(1,1:n_systems)
+       case(force_evaluation_index)
+          system_stresses(1:6,1:n_systems) = total_system_sums(2:7,1:n_systems)
+       end select
+       deallocate(total_system_sums)
+    end if
+    deallocate(system_sums)
 
-    ! Stop the load timer
-    call timer(stopwatch_0)
+    if(evaluate_atom_contributions)then
+       allocate(total_atom_sums(7,n_collected))
+#ifdef MPI
+       call mpi_allreduce(atom_sums,total_atom_sums,size(atom_sums),mpi_double_precision,&
+            mpi_sum,mpi_comm_world,mpistat)
+#else
+       total_atom_sums = atom_sums
+#endif
+       if(allocated(atom_energies))then
+          if(size(atom_energies) /= n_atoms)then
+             deallocate(atom_energies)
+             deallocate(atom_virials)
+          end if
+       end if
+       if(.not.allocated(atom_energies))then
+          allocate(atom_energies(n_atoms))
+          allocate(atom_virials(6,n_atoms))
+          atom_energies = 0.d0
+          atom_virials = 0.d0
+       end if
+       select case(calculation_type)
+       case(energy_evaluation_index)
+          atom_energies(1:n_atoms) = total_atom_sums(1,1:n_atoms)
+       case(force_evaluation_index)
+          atom_virials(1:6,1:n_atoms) = total_atom_sums(2:7,1:n_atoms)
+       end select
+       deallocate(total_atom_sums)
+    end if
+    deallocate(atom_sums)
 
     ! differentiate between energy, force, and electronegativity evaluation
     select case(calculation_type)
@@ -3979,11 +4229,33 @@ contains
        t5 = t5+t0-t00
        t00 = t0
 
-       if(evaluate_ewald)then
-          call calculate_ewald_energy(atoms,cell,ewald_cutoff,ewald_k_radius,ewald_k_cutoffs,ewald_sigma,&
-               ewald_epsilon,ewald_scaler,.false.,energy,.false.)
+       ! the Coulomb summation does not depend on the potential parameters
+       if(evaluate_ewald .and. .not. parameter_derivative_mode)then
+          if(evaluate_pme)then
+             call calculate_pme_energy(atoms,cell,pme_grid,pme_order,ewald_sigma,&
+                  ewald_epsilon,ewald_scaler,.false.,energy)
+          else
+             call calculate_ewald_energy(atoms,cell,ewald_cutoff,ewald_k_radius,ewald_k_cutoffs,ewald_sigma,&
+                  ewald_epsilon,ewald_scaler,.false.,energy,.false.)
+          end if
 
           total_energy = total_energy + energy
+
+          ! The reciprocal space energy is a quadratic form of the charges,
+          ! so it is split between the atoms as E_i = q_i (dE/dq_i) / 2 = - q_i chi_i / 2,
+          ! where chi_i is the reciprocal space part of the electronegativity.
+          if(evaluate_atom_contributions)then
+             temp_enegs = 0.d0
+             if(evaluate_pme)then
+                call calculate_pme_electronegativities(atoms,cell,pme_grid,pme_order,ewald_sigma,&
+                     ewald_epsilon,ewald_scaler,.false.,temp_enegs)
+             else
+                call calculate_ewald_electronegativities(atoms,cell,ewald_cutoff,ewald_k_radius,&
+                     ewald_k_cutoffs,ewald_sigma,&
+                     ewald_epsilon,ewald_scaler,.false.,temp_enegs,.false.)
+             end if
+             atom_energies(1:n_atoms) = atom_energies(1:n_atoms) - 0.5d0*atoms(1:n_atoms)%charge*temp_enegs(1:n_atoms)
+          end if
        call mpi_wall_clock(t0)
        t6 = t6+t0-t00
 
@@ -4014,11 +4286,25 @@ contains
        t5 = t5+t0-t00
        t00 = t0
 
-       if(evaluate_ewald)then
-          call calculate_ewald_forces(atoms,cell,ewald_cutoff,ewald_k_radius,ewald_k_cutoffs,ewald_sigma,&
-               ewald_epsilon,ewald_scaler,.false.,temp_forces,stress,.false.)
+       ! the Coulomb summation does not depend on the potential parameters
+       if(evaluate_ewald .and. .not. parameter_derivative_mode)then
+          if(evaluate_pme)then
+             call calculate_pme_forces(atoms,cell,pme_grid,pme_order,ewald_sigma,&
+                  ewald_epsilon,ewald_scaler,.false.,temp_forces,stress)
+          else
+             call calculate_ewald_forces(atoms,cell,ewald_cutoff,ewald_k_radius,ewald_k_cutoffs,ewald_sigma,&
+                  ewald_epsilon,ewald_scaler,.false.,temp_forces,stress,.false.)
+          end if
           total_forces = total_forces + temp_forces
           total_stress = total_stress + stress
+
+          ! The reciprocal space virial cannot be attributed to
+          ! individual atoms, so it is divided evenly between them.
+          if(evaluate_atom_contributions)then
+             do index1 = 1, n_atoms
+                atom_virials(1:6,index1) = atom_virials(1:6,index1) + stress / n_atoms
+             end do
+          end if
        end if
        call mpi_wall_clock(t0)
        t6 = t6+t0-t00
@@ -4042,11 +4328,17 @@ contains
 #endif
 
        ! ewald summation
-       if(evaluate_ewald)then
+       ! the Coulomb summation does not depend on the potential parameters
+       if(evaluate_ewald .and. .not. parameter_derivative_mode)then
           temp_enegs = 0.d0
-          call calculate_ewald_electronegativities(atoms,cell,ewald_cutoff,ewald_k_radius,&
-               ewald_k_cutoffs,ewald_sigma,&
-               ewald_epsilon,ewald_scaler,.false.,temp_enegs,.false.)
+          if(evaluate_pme)then
+             call calculate_pme_electronegativities(atoms,cell,pme_grid,pme_order,ewald_sigma,&
+                  ewald_epsilon,ewald_scaler,.false.,temp_enegs)
+          else
+             call calculate_ewald_electronegativities(atoms,cell,ewald_cutoff,ewald_k_radius,&
+                  ewald_k_cutoffs,ewald_sigma,&
+                  ewald_epsilon,ewald_scaler,.false.,temp_enegs,.false.)
+          end if
           total_enegs = total_enegs + temp_enegs
        end if
 
@@ -4059,19 +4351,15 @@ contains
     call core_empty_bond_order_storage()
 
     call mpi_wall_clock(tb)
-    t9 = t1+t2+t3+t4+t5+t6+t7+td
+    t9 = t1+t2+t5+t6
     t8 = tb-ta
     if(.false.)then
     write(*,*) ""
     write(*,'(A)') "evaluation timing"
     write(*,'(A, F7.3, F7.1, A)') "bond_factors: ", t1,  100*t1/t8, " %"
-    write(*,'(A, F7.3, F7.1, A)') "singlets:     ", t2,  100*t2/t8, " %"
-    write(*,'(A, F7.3, F7.1, A)') "distances:    ", t3,  100*t3/t8, " %"
-    write(*,'(A, F7.3, F7.1, A)') "doublets:     ", t4,  100*t4/t8, " %"
-    write(*,'(A, F7.3, F7.1, A)') "manybody:     ", td,  100*td/t8, " %"
+    write(*,'(A, F7.3, F7.1, A)') "local:        ", t2,  100*t2/t8, " %"
     write(*,'(A, F7.3, F7.1, A)') "mpi:          ", t5,  100*t5/t8, " %"
     write(*,'(A, F7.3, F7.1, A)') "ewald:        ", t6,  100*t6/t8, " %"
-    write(*,'(A, F7.3, F7.1, A)') "clear:        ", t7,  100*t7/t8, " %"
     write(*,'(A, F7.3)') "sum:          ", t9
     write(*,'(A, F7.3)') "total:        ", t8
     write(*,*) ""
@@ -4082,1285 +4370,1300 @@ contains
   end subroutine core_loop_over_local_interactions
 
 
-  ! Evaluates the local potential affecting a single atom
+! !!!: core_evaluate_local_interactions_of_packed_atom
+
+  ! Evaluates the contributions of local potentials from the interactions
+  ! of the given atom as :func:`core_evaluate_local_interactions_of_atom`,
+  ! and also adds the energy and stress to the sums of the system the atom belongs to,
+  ! when several systems are packed in the core (see :func:`core_pack_systems`).
+  ! Since all the interactions of an atom are within its own system,
+  ! the energies and stresses of the systems add up to the totals.
   !
   ! *index1 index of the atom
-  ! *atom_singlet the atom that is targeted
-  ! *interaction_indices the interactions targeting the given atom
-  ! *calculation_type specifies if we are evaluating the energy, forces, or electronegativities
+  ! *calculation_type index to specify if the loop calculates energies, forces, or e-negativities
   ! *energy calculated energy
   ! *forces calculated forces
-  ! *stress calculated stress
   ! *enegs calculated electronegativities
-  subroutine core_evaluate_local_singlet(index1, &
-       atom_singlet, &
-       interaction_indices, &
-       calculation_type,energy,forces,stress,enegs)
+  ! *stress calculated stress
+  ! *system_sums energies (first row) and stresses (rows 2-7) of the packed systems
+  ! *atom_sums energies (first row) and virials (rows 2-7) of the atoms, or an empty array if they are not collected
+  ! *manybody_indices work array for storing the indices of many-body potentials, must be at least as long as the number of potentials
+  subroutine core_evaluate_local_interactions_of_packed_atom(index1,calculation_type,&
+       energy,forces,enegs,stress,system_sums,atom_sums,manybody_indices)
     implicit none
-    integer, intent(in) :: calculation_type, index1
-    integer, pointer :: interaction_indices(:)
-    double precision, intent(inout) :: energy, forces(:,:), enegs(:), stress(6)
-    type(atom), intent(in) :: atom_singlet
-    integer :: k, n_targets, n_atoms, index2
-    type(potential) :: interaction
-    double precision, save :: &
-         tmp_energy, tmp_forces(3,1), tmp_enegs(1), &
-         dummy_sep(3,0), dummy_dist(0), bo_virial(6)
-
-    n_atoms = size(atoms)
-
-    ! loop over potentials affecting atom1
-    do k = 1, size(interaction_indices)
-
-       interaction = interactions(interaction_indices(k))
+    integer, intent(in) :: index1, calculation_type
+    double precision, intent(inout) :: energy, forces(:,:), enegs(:), stress(6), system_sums(:,:), atom_sums(:,:)
+    integer, pointer :: manybody_indices(:)
+    double precision :: atom_energy, atom_stress(6)
+    integer :: system_index
 
-       ! filter the potentials according to number of targets
-       call get_number_of_targets_of_potential_index(interaction%type_index,n_targets)
-       if( n_targets == 1 )then
+    atom_energy = 0.d0
+    atom_stress = 0.d0
+    call core_evaluate_local_interactions_of_atom(index1,calculation_type,&
+         atom_energy,forces,enegs,atom_stress,atom_sums,manybody_indices)
 
-          ! differentiate between energy, force, and electronegativity evaluation
-          select case(calculation_type)
-          case(energy_evaluation_index)
+    energy = energy + atom_energy
+    stress = stress + atom_stress
+    system_index = atom_systems(atoms(index1)%index)
+    system_sums(1,system_index) = system_sums(1,system_index) + atom_energy
+    system_sums(2:7,system_index) = system_sums(2:7,system_index) + atom_stress
 
-             !***********************!
-             ! 1-body energy (atom1) !
-             !***********************!
+  end subroutine core_evaluate_local_interactions_of_packed_atom
 
-             ! evaluate the 1-body energy involving atom1
-             call evaluate_energy(1,interaction%n_product,dummy_sep,dummy_dist,&
-                  interaction,tmp_energy,atoms(index1:index1)) ! in Potentials.f90
 
+! !!!: core_evaluate_local_interactions_of_atom
 
-             ! If there is a bond order factor associated with the potential,
-             ! we add the contribution is brings:
-             !
-             ! V = \sum_i b_i v_i
-             if(interaction%pot_index > -1)then
-                call core_get_bond_order_factors(interaction%pot_index,&
-                     bo_factors)
-                     
-                 energy = energy + tmp_energy*bo_factors(index1)
-             else
-                !bo_factors = 1.d0                
-                 energy = energy + tmp_energy
-             end if
+  ! Evaluates the contributions of local potentials to energy, forces, 
+  ! or electronegativities from the interactions of the given atom. 
+  ! The atom is taken as the first atom of the interacting pairs, and
+  ! the triplets and quadruplets are searched starting from these pairs. 
+  ! The contributions are added to the given arrays.
+  !
+  ! This routine is called from :func:`core_loop_over_local_interactions`
+  ! for all atoms in turn, possibly from several threads simultaneously.
+  ! Therefore it must not write in any module variables.
+  !
+  ! *index1 index of the atom
+  ! *calculation_type index to specify if the loop calculates energies, forces, or e-negativities
+  ! *energy calculated energy
+  ! *forces calculated forces
+  ! *enegs calculated electronegativities
+  ! *stress calculated stress
+  ! *atom_sums energies (first row) and virials (rows 2-7) of the atoms, or an empty array if they are not collected (see :func:`core_add_tuple_contributions`)
+  ! *manybody_indices work array for storing the indices of many-body potentials, must be at least as long as the number of potentials
+  ! *focus optional logical array marking the atoms in focus, meant for energy evaluation; if given, only the tuples containing at least one of these atoms are evaluated and included in the sums (see :func:`core_add_tuple_contributions`)
+  subroutine core_evaluate_local_interactions_of_atom(index1,calculation_type,&
+       energy,forces,enegs,stress,atom_sums,manybody_indices,focus)
+    implicit none
+    integer, intent(in) :: index1, calculation_type
+    double precision, intent(inout) :: energy, forces(:,:), enegs(:), stress(6), atom_sums(:,:)
+    integer, pointer :: manybody_indices(:)
+    logical, optional, intent(in) :: focus(:)
+    integer :: j, l, m, index2, index3, index4, n_manybody, n_nbors, &
+         offset(3), tripleoffset(3), quadoffset(3)
+    double precision :: separations(3,3), distances(3), directions(3,3), &
+         inv_eps_4pi, inv_sigma_sqrt_2, inv_sigma_sqrt_2pi, inv_sigma_sqrt_2perpi, inv_sigma_sq_2, &
+         charge1, charge2, inv_dist, tmp_forces(3), tmp_eneg, &
+         tuple_energy, tuple_stress(6)
+    type(atom) :: atom1, atom2, atom3, atom4
+    type(atom) :: atom_list(4)
+    type(neighbor_list) :: nbors1, nbors2, nbors3
+    integer, pointer :: interaction_indices(:)
+    logical :: many_bodies_found, in_focus, pair_in_focus, triplet_in_focus
 
-          case(force_evaluation_index)
+    n_manybody = 0
+    tuple_energy = 0.d0
+    tuple_stress = 0.d0
+
+    if(evaluate_ewald)then
+       inv_eps_4pi = 1.d0 / (4.d0 * pi * ewald_epsilon)
+       inv_sigma_sqrt_2 = 1.d0 / (sqrt(2.d0) * ewald_sigma)
+       inv_sigma_sqrt_2pi = 1.d0 / (sqrt(2.d0 * pi) * ewald_sigma)
+       inv_sigma_sq_2 = inv_sigma_sqrt_2*inv_sigma_sqrt_2
+       inv_sigma_sqrt_2perpi = 2.d0 * inv_sigma_sqrt_2pi
+    end if
 
-             !**********************!
-             ! 1-body force (atom1) !
-             !**********************!
+    ! Bond order gradients are not stored since there are potentially
+    ! so many. Some most recent ones are saved, though.
+    ! At the start of the first atom loop, we clear the storage.
+    ! call core_empty_bond_order_gradient_storage()
 
-             ! evaluate the 1-body force involving atom1
-             call evaluate_forces(1,interaction%n_product,dummy_sep,dummy_dist,&
-                  interaction,tmp_forces(1:3,1),atoms(index1:index1)) ! in Potentials.f90
+    atom1 = atoms(index1)
+    nbors1 = atom1%neighbor_list
+    interaction_indices => atom1%potential_indices
 
-             ! If there is a bond order factor associated with the potential,
-             ! we add the contribution is brings:
-             !
-             ! V = \sum_i b_i v_i
-             ! F_a = - \nabla_a V 
-             !     = - \sum_i (\nabla_a b_i) v_i + b_i (\nabla_a v_i)
-             !     = - \sum_i (\nabla_a b_i) v_i + b_i f_a,i
-             !
-             if(interaction%pot_index > -1)then
-                call core_get_bond_order_factors(interaction%pot_index,&
-                     bo_factors)
-                
-                !call core_get_bond_order_gradients(interaction%pot_index,&
-                !     index1,& ! atom index
-                !     1, & ! slot_index
-                !     bo_gradients(1:3,1:n_atoms,1),&
-                !     bo_virial)
+    !*********************!
+    ! 1-body interactions !
+    !*********************!
 
-                ! Add the bond order gradient terms involving the atom1 self energy for all atoms.
-                ! That is, add the (\nabla_a b_i) v_i term with the given i (atom1) for all a.
-                call evaluate_energy(1,interaction%n_product,dummy_sep,dummy_dist,interaction,&
-                     tmp_energy,atoms(index1:index1))  ! in Potentials.f90
-!!$                forces(1:3,1:n_atoms) = forces(1:3,1:n_atoms) - &
-!!$                     tmp_energy*bo_gradients(1:3,1:n_atoms,1)
-                
-                !do index2 = 1, n_atoms
-                !   if(bo_scaling(index2))then
-                !      forces(1:3,index2) = forces(1:3,index2) - tmp_energy*bo_gradients(1:3,index2,1)
-                !   end if
-                !end do
+    in_focus = .true.
+    if(present(focus))then
+       in_focus = focus(index1)
+    end if
+    if(in_focus)then
+       call core_evaluate_local_singlet(index1, &
+            atom1,&
+            interaction_indices,&
+            calculation_type,tuple_energy,forces,tuple_stress,enegs)
+       call core_add_tuple_contributions((/ index1 /),tuple_energy,tuple_stress,&
+            energy,stress,atom_sums,focus)
+    end if
 
-                call core_add_bond_order_forces( &
-                     interaction%pot_index, index1, tmp_energy, &
-                     forces, stress )
+    ! The real space Ewald sum needs all the neighbors,
+    ! the local potentials only the ones within the tier
+    ! of the potential cutoffs.
+    if(evaluate_ewald)then
+       n_nbors = nbors1%n_neighbors
+    else
+       n_nbors = neighbors_within(nbors1,atom1%max_potential_radius) ! in Geometry.f90
+    end if
 
-                ! Add the contribution of bond order gradients to the stress tensor
-                !stress(1:6) = stress(1:6) - tmp_energy*bo_virial(1:6)
+    ! loop over neighbors
+    do j = 1, n_nbors
 
-                ! Add the force due to potential gradient             
-                !forces(1:3,index1) = forces(1:3,index1) + &
-                !     tmp_forces(1:3,1)*bo_factors(index1)
 
-             else
+       ! Note that we loop over the neighbors in the outer loop and
+       ! over the interactions in the inner loop. This is to avoid calculating
+       ! the interatomic distances repeatedly for multiple potentials affecting
+       ! the same pair of atoms.
 
-                 ! Add the force due to potential gradient             
-                 forces(1:3,index1) = forces(1:3,index1) + &
-                      tmp_forces(1:3,1)
+       ! neighboring atom
+       index2 = nbors1%neighbors(j)
+       offset(1:3) = nbors1%pbc_offsets(1:3,j) ! offset atom1 -> atom2
+
+       ! Since we loop over the neighbors of all atoms, we will find the pair
+       ! atom1-atom2 = atom2-atom1 twice.
+       ! To prevent the double counting, we filter by index2 > index1.
+       if(pick(index1,index2,offset))then
+
+          ! If only the tuples in focus are needed, the pairs outside the focus
+          ! are not evaluated. They are only searched for the many-body tuples 
+          ! containing atoms in focus, so if there are no many-body potentials, 
+          ! such pairs can be skipped right away.
+          pair_in_focus = .true.
+          if(present(focus))then
+             pair_in_focus = focus(index1) .or. focus(index2)
+             if(.not.(pair_in_focus .or. manybody_potentials_present))then
+                cycle
              end if
+          end if
 
+          ! Empty bond gradient storage for atom2 slot (since we have a new atom2)
+          ! call core_empty_bond_order_gradient_storage(2)
 
-          case(electronegativity_evaluation_index)
-
-             !**********************************!
-             ! 1-body electronegativity (atom1) !
-             !**********************************!
+          
+          atom2 = atoms(index2)
+          atom_list(1) = atom1
+          atom_list(2) = atom2
+          
+          ! calculate atom1-atom2 separation vector
+          ! and distance
+          call separation_vector(atom1%position, &
+               atom2%position, &
+               nbors1%pbc_offsets(1:3,j), &
+               core_cell_of_atom(atom1%index), &
+               separations(1:3,1)) ! in Geometry.f90
+          distances(1) = .norm.(separations(1:3,1))
+          if(distances(1) == 0.d0)then
+             directions(1:3,1) = (/ 0.d0, 0.d0, 0.d0 /)
+          else
+             directions(1:3,1) = separations(1:3,1) / distances(1)
+          end if
 
-             ! evaluate the 1-body energy involving atom1
-             call evaluate_electronegativity(1,interaction%n_product,dummy_sep,dummy_dist,&
-                  interaction,tmp_enegs(1),atoms(index1:index1)) ! in Potentials.f90
+          !*********************!
+          ! 2-body interactions !
+          !*********************!
 
-             ! If there is a bond order factor associated with the potential,
-             ! we add the contribution is brings:
-             if(interaction%pot_index > -1)then
-                call core_get_bond_order_factors(interaction%pot_index,&
-                     bo_factors)
 
-                 ! Add the electronegativity due to potential gradient
-                 enegs(index1) = enegs(index1) + tmp_enegs(1)*bo_factors(index1)
-             else
+          ! include the realspace part of ewald already here
+          if(evaluate_ewald .and. pair_in_focus)then
+             if(distances(1) < ewald_cutoff)then
+                charge1 = atom1%charge
+                charge2 = atom2%charge
 
-                 ! Add the electronegativity due to potential gradient
-                 enegs(index1) = enegs(index1) + tmp_enegs(1)
-             end if
+                select case(calculation_type)
+                case(energy_evaluation_index)
+                   ! q_i q_j / r * erfc(r / (sqrt(2) sigma))
+                   tuple_energy = charge1*charge2*(1.d0 - erf(distances(1)*inv_sigma_sqrt_2))/&
+                        (distances(1)) * inv_eps_4pi
+                case(force_evaluation_index)
+                   ! q_i q_j * 
+                   ! ( erfc(r/(sigma*sqrt(2)))/r^2 + 
+                   ! 1/sigma sqrt(2/pi) exp(-r^2/(2 sigma^2))/r ) \hat{r} 
+                   inv_dist = 1/distances(1)
+                   tmp_forces =  -inv_eps_4pi * charge1*charge2 * ( &
+                        ( 1 - erf(distances(1)*inv_sigma_sqrt_2) ) * inv_dist*inv_dist + &
+                        inv_sigma_sqrt_2perpi * exp( -distances(1)*distances(1)*inv_sigma_sq_2 ) * inv_dist  ) * &
+                        separations(1:3,1) * inv_dist
+                   forces(1:3,index1) = forces(1:3,index1) + tmp_forces
+                   forces(1:3,index2) = forces(1:3,index2) - tmp_forces
 
+                   !***************!
+                   ! stress tensor !
+                   !***************!
 
-          end select
+                   ! s_xx, s_yy, s_zz, s_yz, s_xz, s_xy:
+                   tuple_stress(1) = - separations(1,1) * tmp_forces(1)
+                   tuple_stress(2) = - separations(2,1) * tmp_forces(2)
+                   tuple_stress(3) = - separations(3,1) * tmp_forces(3)
+                   tuple_stress(4) = - separations(2,1) * tmp_forces(3)
+                   tuple_stress(5) = - separations(1,1) * tmp_forces(3)
+                   tuple_stress(6) = - separations(1,1) * tmp_forces(2)
 
-       end if
-    end do
+                case(electronegativity_evaluation_index)
 
+                   ! q_j / r * erfc(r / (sqrt(2) sigma))
+                   tmp_eneg = -inv_eps_4pi/distances(1)*(1.d0 - erf(distances(1)*inv_sigma_sqrt_2))
+                   
+                   enegs(index1) = enegs(index1) + charge2*tmp_eneg
+                   enegs(index2) = enegs(index2) + charge1*tmp_eneg
 
-  end subroutine core_evaluate_local_singlet
+                end select
+                call core_add_tuple_contributions((/ index1, index2 /),tuple_energy,tuple_stress,&
+                     energy,stress,atom_sums,focus)
+             end if
+          end if
 
+          if(distances(1) < atom1%max_potential_radius)then
+             ! differentiate between energy, force, and electronegativity evaluation
+             select case(calculation_type)
+             case(energy_evaluation_index)
+                call core_evaluate_local_doublet_energy_B(atom_list(1:2), &
+                     index1, index2, &
+                     2, & ! test for atom2, since interaction indices filters for atom1 already
+                     interaction_indices, &
+                     separations(1:3,1), directions(1:3,1), distances(1), &
+                     tuple_energy, &
+                     many_bodies_found, &
+                     manybody_indices, &
+                     n_manybody, &
+                     .not.pair_in_focus )
+             case(force_evaluation_index)
+                call core_evaluate_local_doublet_forces_B(atom_list(1:2), &
+                     index1, index2, &
+                     2, & ! test for atom2, since interaction indices filters for atom1 already
+                     interaction_indices, &
+                     separations(1:3,1), directions(1:3,1), distances(1), &
+                     forces,tuple_stress, &
+                     many_bodies_found, &
+                     manybody_indices, &
+                     n_manybody )
+             case(electronegativity_evaluation_index)
+                call core_evaluate_local_doublet_electronegativities_B(atom_list(1:2), &
+                     index1, index2, &
+                     2, & ! test for atom2, since interaction indices filters for atom1 already
+                     interaction_indices, &
+                     separations(1:3,1), directions(1:3,1), distances(1), &
+                     enegs, &
+                     many_bodies_found, &
+                     manybody_indices, &
+                     n_manybody )
+             end select
+             call core_add_tuple_contributions((/ index1, index2 /),tuple_energy,tuple_stress,&
+                  energy,stress,atom_sums,focus)
+          end if
 
- 
+          ! Only do the 3-body loop if we found many-body potentials 
+          ! during 2-body evaluation.
+          ! 
+          ! In the 3-body loop, we search the neighbors of both atom1
+          ! and atom2 to find the triplets 
+          ! atom1-atom2-atom3 and
+          ! atom2-atom1-atom3
+          ! These are considered to be different, since the middle atom of
+          ! the triplet is different (atom2 vs. atom1).
+          !
+          ! We loop over all atoms to get atom1, 
+          ! then over the neighbors of the atom1 to get atom2,
+          ! then again over the neighbors of both atom1 and atom2 to get atom3.
+          ! We want to find every triplet A-B-C, B-A-C, A-C-B exactly once filtering by the
+          ! ordering of the indices of the atoms.
+          ! Triplets A-B-C are considered equal to C-B-A and should be only found once.
+          !
+          ! Consider the indices A: 1, B: 2, C: 3. For other orderings, we can just
+          ! permutate the names A, B and C so this is not affecting the generality
+          ! of the argument.
+          !
+          ! We already filter by index1 < index2 when searching for atom2.
+          ! Therefore the possible ways to get atom1 and atom2 for these orderings are:
+          !
+          !  A B C   atom1 atom2  or  atom1 atom2  or  atom1 atom2 
+          !  1 2 3   A : 1 B : 2      A : 1 C : 3      B : 2 C : 3
+          !
+          ! If we filter atom3 by index3 > index2 when searching atom1 neighbors
+          ! and index3 > index1 when searching atom2 neighbors (i.e., index3
+          ! greater than the index of the atom whose neighbors are not searched),
+          ! we get:
+          !
+          !  A B C   atom1 atom2  atom3 as atom1 nbor / atom2 nbor
+          !  1 2 3   A : 1 B : 2  C : 3 -> found B-A-C
+          !                       C : 3 -> found A-B-C
+          !          A : 1 C : 3  B : 2 -> B < C (2 < 3) so ignored
+          !                       B : 2 -> found A-C-B
+          !          B : 2 C : 3  A : 1 -> A < B (1 < 2) so ignored
+          !                       A : 1 -> A < C (1 < 3) so ignored
+
+
+          if(many_bodies_found)then
+
+             many_bodies_found = .false.
+
+             !*********************!
+             ! 3-body interactions !
+             !*********************!
+
+             ! neighbors of atom2
+             nbors2 = atom2%neighbor_list
+
+             ! First we try to find ordered triplets atom2 -- atom1 -- atom3
+             ! Therefore we need separations a2--a1 and a1--a3.
+             separations(1:3,1) = -separations(1:3,1)
+             directions(1:3,1) = -directions(1:3,1)
+
+             ! loop over neighbors atom 1
+             do l = 1, neighbors_within(nbors1,atom1%max_potential_radius)
+                index3 = nbors1%neighbors(l)
+
+                ! the condition for finding each triplet once is such that
+                ! index 3 must be higher than the index of the atom whose
+                ! neighbors are NOT currently searched
+                ! For the offset check we need atom2->atom3 which equals
+                ! (atom1->atom3) - (atom1->atom2), the latter being stored in offset
+                tripleoffset = nbors1%pbc_offsets(1:3,l)-offset ! offset atom2 -> atom3
+                if(pick(index2,index3,tripleoffset))then
+
+                   ! If only the tuples in focus are needed, the triplets outside
+                   ! the focus are skipped unless they are needed for finding quadruplets.
+                   triplet_in_focus = .true.
+                   if(present(focus))then
+                      triplet_in_focus = pair_in_focus .or. focus(index3)
+                      if(.not.(triplet_in_focus .or. quadruplet_potentials_present))then
+                         cycle
+                      end if
+                   end if
 
+                   ! third atom of the triplet
+                   atom3 = atoms(index3)
+                   ! The list of atoms is passed to force evaluation routine
+                   ! for further filtering.
+                   ! This is triplet atom2 - atom1 - atom3, since we loop over
+                   ! neighbors of atom1.
+                   atom_list(1:3) = (/ atom2, atom1, atom3 /)
+
+                   ! Calculate the separations and distances between the particles
+                   ! starting from atom2: a2--a1, a1--a3
+                   ! (atom2 -- atom1 is already known though from 2-body calculation)
+                   call separation_vector(atom1%position, &
+                        atom3%position, &
+                        nbors1%pbc_offsets(1:3,l), &
+                        core_cell_of_atom(atom1%index), &
+                        separations(1:3,2)) ! in Geometry.f90
+                   distances(2) = .norm.(separations(1:3,2))
+                   if(distances(2) == 0.d0)then
+                      directions(1:3,2) = (/ 0.d0, 0.d0, 0.d0 /)
+                   else
+                      directions(1:3,2) = separations(1:3,2) / distances(2)
+                   end if
 
-  ! Evaluates the local potential affecting two atoms. (Rearranged internally compared to 'A'.)
-  !
-  ! *index1 index of the atom 1
-  ! *index2 index of the atom 2
-  ! *atom_doublet the atoms that are targeted
-  ! *test_index1 if 1, test if the ineraction targets atom1; similarly for 2
-  ! *interaction_indices the interactions targeting the given atoms
-  ! *separations distance vector from 1 to 2, as an array
-  ! *directions unit vector from 1 to 2, as an array
-  ! *distances distance from 1 to 2, as an array
-  ! *energy calculated energy
-  ! *many_bodies_found returns true if the loop finds an interaction with 3 or more targets
-  subroutine core_evaluate_local_doublet_energy_B(atom_doublet, &
-       index1, index2, &
-       test_index1, &
-       interaction_indices, &
-       separations, directions, distances, &
-       energy, &
-       many_bodies_found, &
-       manybody_indices, &
-       n_manybody)
-    implicit none
-    integer, intent(in) :: index1, index2, test_index1
-    integer, intent(out) :: n_manybody
-    integer, pointer :: interaction_indices(:), manybody_indices(:)
-    double precision, intent(inout) :: energy
-    type(atom), intent(in) :: atom_doublet(2)
-    double precision, intent(in) :: separations(3,1), directions(3,1), distances(1)
-    logical, intent(out) :: many_bodies_found
-    
-    type(atom) :: atom1, atom2
-    integer :: k, n_targets, index_pair(2)
-    type(potential) :: interaction
-    double precision :: &
-         tmp_energy, &
-         cut_factors(1), pair_bo_factors(2), pair_bo_sums(2)
-    logical :: is_active
 
-    many_bodies_found = .false.
-    n_manybody = 0
-    atom1 = atom_doublet(1)
-    atom2 = atom_doublet(2)
-    index_pair = (/ index1, index2 /)
+                   if(distances(2) < atom1%max_potential_radius)then
+                      call core_evaluate_local_triplet_B(atom_list(1:3), &
+                           index2, index1, index3, & ! atom2 - atom1 - atom3
+                           1, 3, & ! atom1 is 2nd in the triplet, so test for 1st and 3rd
+                           !interaction_indices, &
+                           separations(1:3,1:2), directions(1:3,1:2), distances(1:2), &
+                           calculation_type, tuple_energy, forces, enegs, tuple_stress, &
+                           many_bodies_found, &
+                           manybody_indices, &
+                           n_manybody, &
+                           .not.triplet_in_focus )
+                      call core_add_tuple_contributions((/ index2, index1, index3 /),tuple_energy,tuple_stress,&
+                           energy,stress,atom_sums,focus)
+                   end if
 
-    ! loop over potentials affecting atom1
-    do k = 1, size(interaction_indices)
+                   if(many_bodies_found)then
 
-       interaction = interactions(interaction_indices(k))
+                      many_bodies_found = .false.
 
-       ! filter the potentials by:
-       ! is atom2 affected by the potential,
-       ! is it a 2-body potential
-       if( interaction%cutoff > distances(1) )then 
-          call potential_affects_atom(interaction,atom_doublet(test_index1),is_active,2) ! in Potentials.f90
-          if( is_active )then 
-             call get_number_of_targets_of_potential_index(interaction%type_index,&
-                  n_targets) ! in Potentials.f90
-             if( n_targets == 2 )then
-                
-                
-                !*****************************!
-                ! 2-body energy (atom1-atom2) !
-                !*****************************!
+                      !*********************!
+                      ! 4-body interactions !
+                      !*********************!
 
-                ! If there is a bond order factor associated with the potential,
-                ! we add the contribution is brings:
-                !
-                ! V = \sum_ij b_ij v_ij
-                ! b_ij = (b_i + b_j) / 2 + B_ij
-                if(interaction%pot_index > -1)then
-                   ! get b_i (for all i, they have been precalculated)
-                   ! call core_get_bond_order_factors(n_atoms,&
-                   !     interaction%pot_index,&
-                   !     bo_factors)
+                      ! We search for atomic chain quadruplets A-B-C-D where the
+                      ! triplet A-B-C or B-C-D is the triplet considered above.
+                      ! Similarly to the triplets, the different quadruplets are found
+                      ! by searching the neighbors of the end atoms of the triplets.
 
+                      ! We have the triplet  atom2 -- atom1 -- atom3, so searching for neighbors of
+                      ! atom2 and atom3 gives quadruplets
+                      ! atom4 -- atom2 -- atom1 -- atom3 and
+                      ! atom2 -- atom1 -- atom3 -- atom4
 
-                   ! get B_ij for this ij (not precalculated)
-                   ! this is 
-                   ! B_ij = (B*_ij + B*_ji) / 2
-                   call core_calculate_pair_bond_order_factor(index_pair, &
-                        separations(1:3,1), distances(1), directions(1:3,1), &
-                        interaction%pot_index, &
-                        pair_bo_sums(1:2))
-                   call core_post_process_pair_bond_order_factor(atom1, &
-                        interaction%pot_index, &
-                        pair_bo_sums(1), &
-                        pair_bo_factors(1))
-                   call core_post_process_pair_bond_order_factor(atom2, &
-                        interaction%pot_index, &
-                        pair_bo_sums(2), &
-                        pair_bo_factors(2))
-                        
-                else
+                      ! first, atom4 -- atom2 -- atom1 -- atom3:
 
-                end if
+                      ! neighbors of atom3 (not yet needed, but later)
+                      nbors3 = atom3%neighbor_list
 
-                ! If a smooth cutoff is present, we add the
-                ! contribution it brings:
-                ! 
-                ! V = \sum_ij v_ij f(r_ij)
-                if(interaction%smoothened)then
-                   ! get f(r_ij)
-                   call smoothening_factor(distances(1),&
-                        interaction%cutoff,interaction%soft_cutoff,&
-                        cut_factors(1)) ! in Potentials.f90
-                else
-                   cut_factors(1) = 1.d0
-                end if
+                      ! we need separations a4-a2, a2-a1, a1-a3, the latter two are already
+                      ! known but in the wrong place
+                      separations(1:3,2:3) = separations(1:3,1:2)
+                      directions(1:3,2:3) = directions(1:3,1:2)
+                      distances(2:3) = distances(1:2)
 
-                ! evaluate the 2-body energy involving atom1-atom2 interaction
-                call evaluate_energy(2,interaction%n_product,separations(1:3,1),distances(1),&
-                     interaction,tmp_energy,atom_doublet)  ! in Potentials.f90
+                      ! loop over neighbors atom 2
+                      do m = 1, neighbors_within(nbors2,atom2%max_potential_radius)
+                         index4 = nbors2%neighbors(m)
 
-                    
-                ! add the term: b_ij v_ij f(rij)
-                if(interaction%pot_index > -1)then
-                    energy = energy + tmp_energy*cut_factors(1)*&
-                         (saved_bond_order_factors(index1,group_index_save_slot(interaction%pot_index))+&
-                         saved_bond_order_factors(index2,group_index_save_slot(interaction%pot_index))+&
-                         pair_bo_factors(1)+pair_bo_factors(2))*0.5d0
+                         ! the condition for finding each triplet once is such that
+                         ! index 4 must be higher than the index of the atom whose
+                         ! neighbors are NOT currently searched
+                         ! For the offset check we need atom3->atom4 which equals
+                         ! (atom2->atom4) - (atom2->atom3), the latter being stored in tripleoffset
+                         quadoffset = nbors2%pbc_offsets(1:3,m)-tripleoffset ! offset atom3 -> atom4
+                         if(pick(index3,index4,quadoffset) .and. &
+                            index4 /= index1)then
 
-                else
-                    energy = energy + tmp_energy*cut_factors(1)
-                end if
+                            ! skip the quadruplets outside the focus
+                            if(.not.triplet_in_focus)then
+                               if(.not.focus(index4))then
+                                  cycle
+                               end if
+                            end if
 
-          else if(n_targets > 2)then
+                            ! fourth atom of the quadruplet
+                            atom4 = atoms(index4)
+                            ! The list of atoms is passed to force evaluation routine
+                            ! for further filtering.
+                            atom_list(1:4) = (/ atom4, atom2, atom1, atom3 /)
+
+                            call separation_vector(atom4%position, &
+                                 atom2%position, &
+                                 -nbors2%pbc_offsets(1:3,m), &
+                                 core_cell_of_atom(atom4%index), &
+                                 separations(1:3,1)) ! in Geometry.f90
+                            distances(1) = .norm.(separations(1:3,1))
+                            if(distances(1) == 0.d0)then
+                               directions(1:3,1) = (/ 0.d0, 0.d0, 0.d0 /)
+                            else
+                               directions(1:3,1) = separations(1:3,1) / distances(1)
+                            end if
 
-             ! If the number of targets is greater than 2,
-             ! we have found a many-body potential.
-             ! Make a note that we must also evaluate the many-body terms.
-             many_bodies_found = .true.
-             n_manybody = n_manybody + 1
-             manybody_indices(n_manybody) = interaction_indices(k)
+                            if(distances(1) < atom2%max_potential_radius)then
+                               call core_evaluate_local_quadruplet_B(atom_list(1:4), &
+                                 index4, index2, index1, index3, & ! atom4 - atom2 - atom1 - atom3
+                                 1, 2, 4, & ! atom1 is 3rd in the quadruplet
+                                 !interaction_indices, &
+                                 separations(1:3,1:3), directions(1:3,1:3), distances(1:3), &
+                                 calculation_type, tuple_energy, forces, enegs, tuple_stress, &
+                                 many_bodies_found, &
+                                 manybody_indices, &
+                                 n_manybody )
+                               call core_add_tuple_contributions((/ index4, index2, index1, index3 /),tuple_energy,tuple_stress,&
+                                    energy,stress,atom_sums,focus)
+                            end if
 
-          end if ! n_targets == 2
+                         end if ! index4 > index3
+                      end do ! m = 1, nbors2%n_neighbors
 
-       end if ! is_active
-       end if ! cutoff
-    end do ! k
+                      ! move the a2-a1, a1-a3 separations back to their original place
+                      separations(1:3,1:2) = separations(1:3,2:3)
+                      directions(1:3,1:2) = directions(1:3,2:3)
+                      distances(1:2) = distances(2:3)
 
-  end subroutine core_evaluate_local_doublet_energy_B
 
+                      ! second, atom2 -- atom1 -- atom3 -- atom4:
 
+                      ! we need separations a2-a1, a1-a3, a3-a4, the first two are already
+                      ! known and now in the right place as well
 
-  ! Evaluates the local potential affecting two atoms.
-  !
-  ! *index1 index of the atom 1
-  ! *index2 index of the atom 2
-  ! *atom_doublet the atoms that are targeted
-  ! *test_index1 if 1, test if the ineraction targets atom1; similarly for 2
-  ! *interaction_indices the interactions targeting the given atoms
-  ! *separations distance vector from 1 to 2, as an array
-  ! *directions unit vector from 1 to 2, as an array
-  ! *distances distance from 1 to 2, as an array
-  ! *energy calculated energy
-  ! *many_bodies_found returns true if the loop finds an interaction with 3 or more targets
-  subroutine core_evaluate_local_doublet_energy(n_atoms, &
-       atom_doublet, &
-       index1, index2, &
-       test_index1, &
-       interaction_indices, &
-       separations, directions, distances, &
-       energy, &
-       many_bodies_found)
-    implicit none
-    integer, intent(in) :: n_atoms, index1, index2, test_index1
-    integer, pointer :: interaction_indices(:)
-    double precision, intent(inout) :: energy
-    type(atom), intent(in) :: atom_doublet(2)
-    double precision, intent(in) :: separations(3,1), directions(3,1), distances(1)
-    logical, intent(out) :: many_bodies_found
-    
-    type(atom) :: atom1, atom2
-    integer :: k, n_targets, index_pair(2)
-    type(potential) :: interaction
-    double precision :: bo_factors(n_atoms), bo_sums(n_atoms), &
-         tmp_energy, &
-         cut_factors(1), pair_bo_factors(2), pair_bo_sums(2)
-    logical :: is_active
+                      ! loop over neighbors atom 3
+                      do m = 1, neighbors_within(nbors3,atom3%max_potential_radius)
+                         index4 = nbors3%neighbors(m)
 
-    many_bodies_found = .false.
-    atom1 = atom_doublet(1)
-    atom2 = atom_doublet(2)
-    index_pair = (/ index1, index2 /)
+                         ! the condition for finding each triplet once is such that
+                         ! index 4 must be higher than the index of the atom whose
+                         ! neighbors are NOT currently searched
+                         ! For the offset check we need atom2->atom4 which equals
+                         ! (atom3->atom4) + (atom2->atom3), the latter being stored in tripleoffset
+                         quadoffset = nbors3%pbc_offsets(1:3,m)+tripleoffset ! offset atom2 -> atom4
+                         if(pick(index2,index4,quadoffset) .and. &
+                              index4 /= index1)then
 
-    ! loop over potentials affecting atom1
-    do k = 1, size(interaction_indices)
+                            ! skip the quadruplets outside the focus
+                            if(.not.triplet_in_focus)then
+                               if(.not.focus(index4))then
+                                  cycle
+                               end if
+                            end if
 
-       interaction = interactions(interaction_indices(k))
+                            ! fourth atom of the quadruplet
+                            atom4 = atoms(index4)
+                            ! The list of atoms is passed to force evaluation routine
+                            ! for further filtering.
+                            atom_list(1:4) = (/ atom2, atom1, atom3, atom4 /)
+
+                            call separation_vector(atom3%position, &
+                                 atom4%position, &
+                                 nbors3%pbc_offsets(1:3,m), &
+                                 core_cell_of_atom(atom3%index), &
+                                 separations(1:3,3)) ! in Geometry.f90
+                            distances(3) = .norm.(separations(1:3,3))
+                            if(distances(3) == 0.d0)then
+                               directions(1:3,3) = (/ 0.d0, 0.d0, 0.d0 /)
+                            else
+                               directions(1:3,3) = separations(1:3,3) / distances(3)
+                            end if
 
-       ! filter the potentials by:
-       ! is atom2 affected by the potential,
-       ! is it a 2-body potential
-       if( interaction%cutoff > distances(1) )then 
-       call potential_affects_atom(interaction,atom_doublet(test_index1),is_active,2) ! in Potentials.f90
-       if( is_active )then 
-          call get_number_of_targets_of_potential_index(interaction%type_index,&
-               n_targets) ! in Potentials.f90
-          if( n_targets == 2 )then
+                            if(distances(3) < atom3%max_potential_radius)then
+                               call core_evaluate_local_quadruplet_B(atom_list(1:4), &
+                                    index2, index1, index3, index4, & ! atom2 - atom1 - atom3 - atom4
+                                    1, 3, 4, & ! atom1 is 2nd in the quadruplet
+                                    !interaction_indices, &
+                                    separations(1:3,1:3), directions(1:3,1:3), distances(1:3), &
+                                    calculation_type, tuple_energy, forces, enegs, tuple_stress, &
+                                    many_bodies_found, &
+                                    manybody_indices, &
+                                    n_manybody )
+                               call core_add_tuple_contributions((/ index2, index1, index3, index4 /),tuple_energy,tuple_stress,&
+                                    energy,stress,atom_sums,focus)
+                            end if
 
+                         end if ! index4 > index3
+                      end do ! m = 1, nbors3%n_neighbors
 
-                !*****************************!
-                ! 2-body energy (atom1-atom2) !
-                !*****************************!
+                   end if ! many_bodies_found
 
-                ! If there is a bond order factor associated with the potential,
-                ! we add the contribution is brings:
-                !
-                ! V = \sum_ij b_ij v_ij
-                ! b_ij = (b_i + b_j) / 2 + B_ij
-                if(interaction%pot_index > -1)then
-                   ! get b_i (for all i, they have been precalculated)
-                   call core_get_bond_order_factors(interaction%pot_index,&
-                        bo_factors)
+                end if ! index3 > index2
 
-                   ! get B_ij for this ij (not precalculated)
-                   ! this is 
-                   ! B_ij = (B*_ij + B*_ji) / 2
-                   call core_calculate_pair_bond_order_factor(index_pair, &
-                        separations(1:3,1), distances(1), directions(1:3,1), &
-                        interaction%pot_index, &
-                        pair_bo_sums(1:2))
-                   call core_post_process_pair_bond_order_factor(atom1, &
-                        interaction%pot_index, &
-                        pair_bo_sums(1), &
-                        pair_bo_factors(1))
-                   call core_post_process_pair_bond_order_factor(atom2, &
-                        interaction%pot_index, &
-                        pair_bo_sums(2), &
-                        pair_bo_factors(2))
+             end do ! l = 1, nbors1%n_neighbors
 
-                else
-                   !bo_factors = 1.d0
-                end if
+             many_bodies_found = .false.
 
-                ! If a smooth cutoff is present, we add the
-                ! contribution it brings:
-                ! 
-                ! V = \sum_ij v_ij f(r_ij)
-                if(interaction%smoothened)then
-                   ! get f(r_ij)
-                   call smoothening_factor(distances(1),&
-                        interaction%cutoff,interaction%soft_cutoff,&
-                        cut_factors(1)) ! in Potentials.f90
-                else
-                   cut_factors(1) = 1.d0
-                end if
+             ! Next we try to find ordered triplets atom1 -- atom2 -- atom3
+             ! Therefore we need separations a1--a2 and a2--a3.
+             separations(1:3,1) = -separations(1:3,1)
+             directions(1:3,1) = -directions(1:3,1)
 
-                ! evaluate the 2-body energy involving atom1-atom2 interaction
-                call evaluate_energy(2,interaction%n_product,separations(1:3,1),distances(1),&
-                     interaction,tmp_energy,atom_doublet)  ! in Potentials.f90
+             ! loop over neighbors of atom 2
+             do l = 1, neighbors_within(nbors2,atom2%max_potential_radius)
+                index3 = nbors2%neighbors(l)
 
-                ! add the term: b_ij v_ij f(rij)
-                if(interaction%pot_index > -1)then
-                    energy = energy + tmp_energy*cut_factors(1)*&
-                         (bo_factors(index1)+bo_factors(index2)+pair_bo_factors(1)+pair_bo_factors(2))*0.5d0
-                else
-                    energy = energy + tmp_energy*cut_factors(1)
-                end if
+                ! the condition for finding each triplet once is such that
+                ! index 3 must be higher than the index of the atom whose
+                ! neighbors are NOT currently searched
+                ! For the offset check we need atom1->atom3 which equals
+                ! (atom1->atom2) + (atom2->atom3), the former being stored in offset
+                tripleoffset = nbors2%pbc_offsets(1:3,l)+offset ! offset atom1 -> atom3
+                if(pick(index1,index3,tripleoffset))then
 
-          else if(n_targets > 2)then
+                   ! skip the triplets outside the focus as above
+                   triplet_in_focus = .true.
+                   if(present(focus))then
+                      triplet_in_focus = pair_in_focus .or. focus(index3)
+                      if(.not.(triplet_in_focus .or. quadruplet_potentials_present))then
+                         cycle
+                      end if
+                   end if
 
-             ! If the number of targets is greater than 2,
-             ! we have found a many-body potential.
-             ! Make a note that we must also evaluate the many-body terms.
-             many_bodies_found = .true.
+                   ! third atom of the triplet
+                   atom3 = atoms(index3)
+                   ! The list of atoms is passed to force evaluation routine
+                   ! for further filtering.
+                   ! This is triplet atom1 - atom2 - atom3, since we loop over
+                   ! neighbors of atom2.
+                   atom_list(1:3) = (/ atom1, atom2, atom3 /)
+
+                   ! Calculate the separations and distances between the particles
+                   ! starting from atom1: a1--a2, a2--a3
+                   ! (atom1 -- atom2 is already known though from 2-body calculation)
+                   call separation_vector(atom2%position, &
+                        atom3%position, &
+                        nbors2%pbc_offsets(1:3,l), &
+                        core_cell_of_atom(atom2%index), &
+                        separations(1:3,2)) ! in Geometry.f90
+                   distances(2) = .norm.(separations(1:3,2))
+                   if(distances(2) == 0.d0)then
+                      directions(1:3,2) = (/ 0.d0, 0.d0, 0.d0 /)
+                   else
+                      directions(1:3,2) = separations(1:3,2)/distances(2)
+                   end if
 
-          end if ! n_targets == 2
+                   if(distances(2) < atom2%max_potential_radius)then
+                      call core_evaluate_local_triplet_B(atom_list(1:3), &
+                           index1, index2, index3, & ! atom1 - atom2 - atom3
+                           2, 3, & ! atom1 is 1st in the triplet, so test for 2nd and 3rd
+                           !interaction_indices, &
+                           separations(1:3,1:2), directions(1:3,1:2), distances(1:2), &
+                           calculation_type, tuple_energy, forces, enegs, tuple_stress, &
+                           many_bodies_found, &
+                           manybody_indices, &
+                           n_manybody, &
+                           .not.triplet_in_focus )
+                      call core_add_tuple_contributions((/ index1, index2, index3 /),tuple_energy,tuple_stress,&
+                           energy,stress,atom_sums,focus)
+                   end if
 
-       end if ! is_active
-       end if ! cutoff
-    end do ! k
+                   if(many_bodies_found)then
 
-  end subroutine core_evaluate_local_doublet_energy
+                      many_bodies_found = .false.
 
+                      !*********************!
+                      ! 4-body interactions !
+                      !*********************!
 
+                      ! We search for atomic chain quadruplets A-B-C-D where the
+                      ! triplet A-B-C or B-C-D is the triplet considered above.
+                      ! Similarly to the triplets, the different quadruplets are found
+                      ! by searching the neighbors of the end atoms of the triplets.
 
-  ! Evaluates the local force affecting two atoms.
+                      ! We have the triplet  atom1 -- atom2 -- atom3, so searching for neighbors of
+                      ! atom1 and atom3 gives quadruplets
+                      ! atom4 -- atom1 -- atom2 -- atom3 and
+                      ! atom1 -- atom2 -- atom3 -- atom4
+
+                      ! first, atom4 -- atom1 -- atom2 -- atom3:
+
+                      ! neighbors of atom3
+                      nbors3 = atom3%neighbor_list
+
+                      ! we need separations a4-a1, a1-a2, a2-a3, the latter two are already
+                      ! known but in the wrong place
+                      separations(1:3,2:3) = separations(1:3,1:2)
+                      directions(1:3,2:3) = directions(1:3,1:2)
+                      distances(2:3) = distances(1:2)
+
+                      ! loop over neighbors atom 1
+                      do m = 1, neighbors_within(nbors1,atom1%max_potential_radius)
+                         index4 = nbors1%neighbors(m)
+
+                         ! the condition for finding each triplet once is such that
+                         ! index 4 must be higher than the index of the atom whose
+                         ! neighbors are NOT currently searched
+                         ! For the offset check we need atom3->atom4 which equals
+                         ! (atom1->atom4) - (atom1->atom3), the latter being stored in tripleoffset
+                         quadoffset = nbors1%pbc_offsets(1:3,m)-tripleoffset ! offset atom3 -> atom4
+                         if(pick(index3,index4,quadoffset) .and. &
+                              index4 /= index2)then
+
+                            ! skip the quadruplets outside the focus
+                            if(.not.triplet_in_focus)then
+                               if(.not.focus(index4))then
+                                  cycle
+                               end if
+                            end if
+
+                            ! fourth atom of the quadruplet
+                            atom4 = atoms(index4)
+                            ! The list of atoms is passed to force evaluation routine
+                            ! for further filtering.
+                            atom_list(1:4) = (/ atom4, atom1, atom2, atom3 /)
+
+                            call separation_vector(atom4%position, &
+                                 atom1%position, &
+                                 -nbors1%pbc_offsets(1:3,m), &
+                                 core_cell_of_atom(atom4%index), &
+                                 separations(1:3,1)) ! in Geometry.f90
+                            distances(1) = .norm.(separations(1:3,1))
+                            if(distances(1) == 0.d0)then
+                               directions(1:3,1) = (/ 0.d0, 0.d0, 0.d0 /)
+                            else
+                               directions(1:3,1) = separations(1:3,1) / distances(1)
+                            end if
+
+
+                            if(distances(1) < atom1%max_potential_radius)then
+                               call core_evaluate_local_quadruplet_B(atom_list(1:4), &
+                                    index4, index1, index2, index3, & ! atom4 - atom1 - atom2 - atom3
+                                    1, 3, 4, & ! atom1 is 2nd in the quadruplet
+                                    !interaction_indices, &
+                                    separations(1:3,1:3), directions(1:3,1:3), distances(1:3), &
+                                    calculation_type, tuple_energy, forces, enegs, tuple_stress, &
+                                    many_bodies_found, &
+                                    manybody_indices, &
+                                    n_manybody )
+                               call core_add_tuple_contributions((/ index4, index1, index2, index3 /),tuple_energy,tuple_stress,&
+                                    energy,stress,atom_sums,focus)
+                            end if
+
+                         end if ! index4 > index3
+                      end do ! m = 1, nbors2%n_neighbors
+
+                      ! move the a1-a2, a2-a3 separations back to their original place
+                      separations(1:3,1:2) = separations(1:3,2:3)
+                      directions(1:3,1:2) = directions(1:3,2:3)
+                      distances(1:2) = distances(2:3)
+
+
+                      ! second, atom1 -- atom2 -- atom3 -- atom4:
+
+                      ! we need separations a1-a2, a2-a3, a3-a4, the first two are already
+                      ! known and now in the right place as well
+
+                      ! loop over neighbors atom 3
+                      do m = 1, neighbors_within(nbors3,atom3%max_potential_radius)
+                         index4 = nbors3%neighbors(m)
+
+                         ! the condition for finding each triplet once is such that
+                         ! index 4 must be higher than the index of the atom whose
+                         ! neighbors are NOT currently searched
+                         ! For the offset check we need atom1->atom4 which equals
+                         ! (atom3->atom4) + (atom1->atom3), the latter being stored in tripleoffset
+                         quadoffset = nbors3%pbc_offsets(1:3,m)+tripleoffset ! offset atom1 -> atom4
+                         if(pick(index1,index4,quadoffset) .and. &
+                              index4 /= index2)then
+
+                            ! skip the quadruplets outside the focus
+                            if(.not.triplet_in_focus)then
+                               if(.not.focus(index4))then
+                                  cycle
+                               end if
+                            end if
+
+                            ! fourth atom of the quadruplet
+                            atom4 = atoms(index4)
+                            ! The list of atoms is passed to force evaluation routine
+                            ! for further filtering.
+                            atom_list(1:4) = (/ atom1, atom2, atom3, atom4 /)
+
+                            call separation_vector(atom3%position, &
+                                 atom4%position, &
+                                 nbors3%pbc_offsets(1:3,m), &
+                                 core_cell_of_atom(atom3%index), &
+                                 separations(1:3,3)) ! in Geometry.f90
+                            distances(3) = .norm.(separations(1:3,3))
+                            if(distances(3) == 0.d0)then
+                               directions(1:3,3) = (/ 0.d0, 0.d0, 0.d0 /)
+                            else
+                               directions(1:3,3) = separations(1:3,3) / distances(3)
+                            end if
+
+
+                            if(distances(3) < atom3%max_potential_radius)then
+                               call core_evaluate_local_quadruplet_B(atom_list(1:4), &
+                                    index1, index2, index3, index4, & ! atom1 - atom2 - atom3 - atom4
+                                    2, 3, 4, & ! atom1 is 1st in the quadruplet
+                                    !interaction_indices, &
+                                    separations(1:3,1:3), directions(1:3,1:3), distances(1:3), &
+                                    calculation_type, tuple_energy, forces, enegs, tuple_stress, &
+                                    many_bodies_found, &
+                                    manybody_indices, &
+                                    n_manybody )
+                               call core_add_tuple_contributions((/ index1, index2, index3, index4 /),tuple_energy,tuple_stress,&
+                                    energy,stress,atom_sums,focus)
+                            end if
+
+                         end if ! index4 > index3
+                      end do ! m = 1, nbors3%n_neighbors
+
+                   end if ! many_bodies_found
+
+                end if ! index3 > index1
+
+             end do ! l
+
+          end if ! many-bodies_found
+
+
+       end if ! index2 > index1
+
+    end do ! j
+
+  end subroutine core_evaluate_local_interactions_of_atom
+
+
+! !!!: core_add_tuple_contributions
+
+  ! Adds the energy and stress of a single interacting atom, pair, triplet
+  ! or quadruplet to the totals and empties the tuple sums for the next tuple.
   !
-  ! *n_atoms total number of atoms in the system
-  ! *index1 index of the atom 1
-  ! *index2 index of the atom 2
-  ! *atom_doublet the atoms that are targeted
-  ! *test_index1 if 1, test if the ineraction targets atom1; similarly for 2
-  ! *interaction_indices the interactions targeting the given atoms
-  ! *separations distance vector from 1 to 2, as an array
-  ! *directions unit vector from 1 to 2, as an array
-  ! *distances distance from 1 to 2, as an array
+  ! If the contributions of individual atoms are collected (see :func:`core_set_atom_contributions`),
+  ! the energy and the stress (virial) of the tuple are also divided evenly between 
+  ! the atoms of the tuple. This way the per-atom energies and virials add up to the totals.
+  ! Otherwise atom_sums is an empty array.
+  !
+  ! If a focus is given, the tuple is only included if at least
+  ! one of its atoms is in focus. This is used for evaluating the
+  ! energy change due to a local modification of the structure
+  ! (see :func:`core_monte_carlo`).
+  !
+  ! *tuple_indices the indices of the atoms in the tuple
+  ! *tuple_energy the energy of the tuple
+  ! *tuple_stress the stress of the tuple
+  ! *energy calculated energy
+  ! *stress calculated stress
+  ! *atom_sums energies (first row) and virials (rows 2-7) of the atoms
+  ! *focus optional logical array marking the atoms in focus
+  subroutine core_add_tuple_contributions(tuple_indices,tuple_energy,tuple_stress,&
+       energy,stress,atom_sums,focus)
+    implicit none
+    integer, intent(in) :: tuple_indices(:)
+    double precision, intent(inout) :: tuple_energy, tuple_stress(6), energy, stress(6), atom_sums(:,:)
+    logical, optional, intent(in) :: focus(:)
+    double precision :: share
+    integer :: i
+
+    if(present(focus))then
+       if(.not.any(focus(tuple_indices)))then
+          tuple_energy = 0.d0
+          tuple_stress = 0.d0
+          return
+       end if
+    end if
+
+    energy = energy + tuple_energy
+    stress = stress + tuple_stress
+
+    if(size(atom_sums,2) > 0)then
+       share = 1.d0 / size(tuple_indices)
+       do i = 1, size(tuple_indices)
+          atom_sums(1,tuple_indices(i)) = atom_sums(1,tuple_indices(i)) + share*tuple_energy
+          atom_sums(2:7,tuple_indices(i)) = atom_sums(2:7,tuple_indices(i)) + share*tuple_stress
+       end do
+    end if
+
+    tuple_energy = 0.d0
+    tuple_stress = 0.d0
+
+  end subroutine core_add_tuple_contributions
+
+
+  ! Evaluates the local potential affecting a single atom
+  !
+  ! *index1 index of the atom
+  ! *atom_singlet the atom that is targeted
+  ! *interaction_indices the interactions targeting the given atom
+  ! *calculation_type specifies if we are evaluating the energy, forces, or electronegativities
+  ! *energy calculated energy
   ! *forces calculated forces
   ! *stress calculated stress
-  ! *many_bodies_found returns true if the loop finds an interaction with 3 or more targets
-  subroutine core_evaluate_local_doublet_forces(n_atoms, &
-       atom_doublet, &
-       index1, index2, &
-       test_index1, &
+  ! *enegs calculated electronegativities
+  subroutine core_evaluate_local_singlet(index1, &
+       atom_singlet, &
        interaction_indices, &
-       separations, directions, distances, &
-       forces,stress, &
-       many_bodies_found)
+       calculation_type,energy,forces,stress,enegs)
     implicit none
-    integer, intent(in) :: n_atoms, index1, index2, test_index1
+    integer, intent(in) :: calculation_type, index1
     integer, pointer :: interaction_indices(:)
-    double precision, intent(inout) :: forces(3,n_atoms), stress(6)
-    type(atom), intent(in) :: atom_doublet(2)
-    double precision, intent(in) :: separations(3,1), directions(3,1), distances(1)
-    logical, intent(out) :: many_bodies_found
-    
-    type(atom) :: atom1, atom2
-    integer :: k, n_targets, index_pair(2)
+    double precision, intent(inout) :: energy, forces(:,:), enegs(:), stress(6)
+    type(atom), intent(in) :: atom_singlet
+    integer :: k, n_targets, n_atoms, index2
     type(potential) :: interaction
-    double precision :: bo_factors(n_atoms), bo_sums(n_atoms), bo_gradients(3,n_atoms,4), &
-         tmp_energy, tmp_forces(3,2), tmp_enegs(2), &
-         cut_factors(1), cut_gradients(3,1), &
-         pair_forces(3,2), bo_virial(6,2), &
-         pair_bo_sums(2), pair_bo_factors(2), &
-         pair_bo_virial(6,2)
-    logical :: is_active
+    double precision :: &
+         tmp_energy, tmp_forces(3,1), tmp_enegs(1), &
+         dummy_sep(3,0), dummy_dist(0), bo_virial(6)
+
+    n_atoms = size(atoms)
 
-    many_bodies_found = .false.
-    atom1 = atom_doublet(1)
-    atom2 = atom_doublet(2)
-    index_pair = (/ index1, index2 /)
-    
     ! loop over potentials affecting atom1
     do k = 1, size(interaction_indices)
 
        interaction = interactions(interaction_indices(k))
 
-       ! filter the potentials by:
-       ! is atom2 affected by the potential,
-       ! is it a 2-body potential
-       if( interaction%cutoff > distances(1) )then 
-       call potential_affects_atom(interaction,atom_doublet(test_index1),is_active,2) ! in Potentials.f90
-       if( is_active )then 
-          call get_number_of_targets_of_potential_index(interaction%type_index,&
-               n_targets) ! in Potentials.f90
-          if( n_targets == 2 )then
+       ! filter the potentials according to number of targets
+       call get_number_of_targets_of_potential_index(interaction%type_index,n_targets)
+       if( n_targets == 1 )then
 
-             !****************************!
-             ! 2-body force (atom1-atom2) !
-             !****************************!
-             
-             ! We will need the energy contribution from atom1-atom2
-             ! interaction if smooth cutoffs or bond factors are used,
-             ! since we are mulplying the potential.
-             if((interaction%pot_index > -1) .or. &
-                  interaction%smoothened)then
-                call evaluate_energy(2,interaction%n_product,separations(1:3,1),distances(1),&
-                     interaction,tmp_energy,atom_doublet) ! in Potentials.f90
-             else
-                tmp_energy = 0.d0
-             end if
-             
-             ! If a smooth cutoff is present, we add the
-             ! contribution it brings:
-             ! 
-             ! V = \sum_ij v_ij f(r_ij)
-             ! F_a = - \nabla_a V 
-             !     = - \sum_ij v_ij f'(r_ij) (\nabla_a r_ij) + (\nabla_a v_ij) f(r_ij) 
-             !     = - \sum_ij v_ij f'(r_ij) (\nabla_a r_ij) + f_a,ij f(r_ij)
+          ! differentiate between energy, force, and electronegativity evaluation
+          select case(calculation_type)
+          case(energy_evaluation_index)
+
+             !***********************!
+             ! 1-body energy (atom1) !
+             !***********************!
+
+             ! evaluate the 1-body energy involving atom1
+             call evaluate_energy(1,interaction%n_product,dummy_sep,dummy_dist,&
+                  interaction,tmp_energy,atoms(index1:index1)) ! in Potentials.f90
+
+
+             ! If there is a bond order factor associated with the potential,
+             ! we add the contribution is brings:
              !
-             if(interaction%smoothened)then
-                ! get f(r_ij)
-                call smoothening_factor(distances(1),&
-                     interaction%cutoff,interaction%soft_cutoff,&
-                     cut_factors(1)) ! in Potentials.f90
-                ! get f'(r_ij) (\nabla_a r_ij)
-                call smoothening_gradient(directions(1:3,1),distances(1),&
-                     interaction%cutoff,interaction%soft_cutoff,&
-                     cut_gradients(1:3,1)) ! in Potentials.f90
+             ! V = \sum_i b_i v_i
+             if(interaction%pot_index > -1)then
+                call core_get_bond_order_factor_of_atom(interaction%pot_index,&
+                     index1,bo_factors(index1))
+                     
+                 energy = energy + tmp_energy*bo_factors(index1)
              else
-                cut_factors(1) = 1.d0
-                cut_gradients(1:3,1) = 0.d0
+                !bo_factors = 1.d0                
+                 energy = energy + tmp_energy
              end if
-             
+
+          case(force_evaluation_index)
+
+             !**********************!
+             ! 1-body force (atom1) !
+             !**********************!
+
+             ! evaluate the 1-body force involving atom1
+             call evaluate_forces(1,interaction%n_product,dummy_sep,dummy_dist,&
+                  interaction,tmp_forces(1:3,1),atoms(index1:index1)) ! in Potentials.f90
+
              ! If there is a bond order factor associated with the potential,
              ! we add the contribution is brings:
              !
-             ! V = \sum_ij b_ij v_ij
-             ! b_ij = (b_i + b_j) / 2 + B_ij
+             ! V = \sum_i b_i v_i
              ! F_a = - \nabla_a V 
-             !     = - \sum_ij (\nabla_a b_ij) v_ij + b_ij (\nabla_a v_ij)
-             !     = - \sum_ij (\nabla_a b_ij) v_ij + b_ij f_a,ij
+             !     = - \sum_i (\nabla_a b_i) v_i + b_i (\nabla_a v_i)
+             !     = - \sum_i (\nabla_a b_i) v_i + b_i f_a,i
              !
              if(interaction%pot_index > -1)then
-                ! get b_i (for all i, they have been precalculated)
                 call core_get_bond_order_factors(interaction%pot_index,&
                      bo_factors)
-                ! get (\nabla_a b_i) (for all a)
-                call core_get_bond_order_gradients(interaction%pot_index,&
-                     index1,& ! atom index
-                     1, & ! slot_index
-                     bo_gradients(1:3,1:n_atoms,1), &
-                     bo_virial(1:6,1))
-                ! get (\nabla_a b_j) (for all a)
-                call core_get_bond_order_gradients(interaction%pot_index,&
-                     index2,& ! atom index
-                     2, & ! slot_index
-                     bo_gradients(1:3,1:n_atoms,2), &
-                     bo_virial(1:6,2))
-                
-                
-                ! get B_ij and \nabla_a B_ij for this ij (not precalculated)
-                ! this is 
-                ! B_ij = (B*_ij + B*_ji) / 2
-                call core_calculate_pair_bond_order_factor(index_pair, &
-                     separations(1:3,1), distances(1), directions(1:3,1), &
-                     interaction%pot_index, &
-                     pair_bo_sums(1:2))
-                call core_post_process_pair_bond_order_factor(atom1, &
-                     interaction%pot_index, &
-                     pair_bo_sums(1), &
-                     pair_bo_factors(1))
-                call core_post_process_pair_bond_order_factor(atom2, &
-                     interaction%pot_index, &
-                     pair_bo_sums(2), &
-                     pair_bo_factors(2))
-                
-                call core_calculate_pair_bond_order_gradients(index_pair, &
-                     separations(1:3,1), distances(1), directions(1:3,1), &
-                     interaction%pot_index, &                        
-                     pair_bo_sums(1:2), &
-                     bo_gradients(1:3,1:n_atoms,3:4), &
-                     pair_bo_virial(1:6,1:2))
-                
-                
-                ! Add the bond order gradient terms involving the 
-                ! atom1-atom2 energy for all atoms.
-                ! That is, add the (\nabla_a b_ij) v_ij term with 
-                ! the given ij (atom1,atom2) for all a.
-                forces(1:3,1:n_atoms) = forces(1:3,1:n_atoms) &
-                     - tmp_energy*cut_factors(1)*&
-                     (bo_gradients(1:3,1:n_atoms,1) + bo_gradients(1:3,1:n_atoms,2) + &
-                     bo_gradients(1:3,1:n_atoms,3) + bo_gradients(1:3,1:n_atoms,4))*0.5d0
-                
-                ! Add the contribution of bond order gradients to the stress tensor
-                stress(1:6) = stress(1:6) - tmp_energy*cut_factors(1)* &
-                     (bo_virial(1:6,1) + bo_virial(1:6,2) + pair_bo_virial(1:6,1) + pair_bo_virial(1:6,2))*0.5d0
                 
-             else
-                !bo_factors = 1.d0
-                !bo_sums = 0.d0
-                !bo_gradients = 0.d0
-             end if
-             
-             ! evaluate the 2-body force involving atom1-atom2 interaction
-             call evaluate_forces(2,interaction%n_product,separations(1:3,1),distances(1),&
-                  interaction,tmp_forces(1:3,1:2),atom_doublet) ! in Potentials.f90
-             
-             if(interaction%pot_index > -1)then
-                ! force on atom 1:                 
-                pair_forces(1:3,1) = ( tmp_forces(1:3,1) * cut_factors(1) + &
-                     tmp_energy * cut_gradients(1:3,1) ) * &
-                     ( bo_factors(index1) + bo_factors(index2) + &
-                     pair_bo_factors(1) + pair_bo_factors(2) ) * 0.5d0
+                !call core_get_bond_order_gradients(interaction%pot_index,&
+                !     index1,& ! atom index
+                !     1, & ! slot_index
+                !     bo_gradients(1:3,1:n_atoms,1),&
+                !     bo_virial)
+
+                ! Add the bond order gradient terms involving the atom1 self energy for all atoms.
+                ! That is, add the (\nabla_a b_i) v_i term with the given i (atom1) for all a.
+                call evaluate_energy(1,interaction%n_product,dummy_sep,dummy_dist,interaction,&
+                     tmp_energy,atoms(index1:index1))  ! in Potentials.f90
+!!$                forces(1:3,1:n_atoms) = forces(1:3,1:n_atoms) - &
+!!$                     tmp_energy*bo_gradients(1:3,1:n_atoms,1)
                 
-                ! force on atom 2:
-                pair_forces(1:3,2) = ( tmp_forces(1:3,2) * cut_factors(1) - &
-                     tmp_energy * cut_gradients(1:3,1) ) * &
-                     ( bo_factors(index1) + bo_factors(index2) + &
-                     pair_bo_factors(1) + pair_bo_factors(2) ) * 0.5d0
-             else
-                pair_forces(1:3,1) = ( tmp_forces(1:3,1) * cut_factors(1) + &
-                     tmp_energy * cut_gradients(1:3,1) )
-                pair_forces(1:3,2) = ( tmp_forces(1:3,2) * cut_factors(1) - &
-                     tmp_energy * cut_gradients(1:3,1) )
-             end if
-             
-             forces(1:3,index1) = forces(1:3,index1) + pair_forces(1:3,1)
-             forces(1:3,index2) = forces(1:3,index2) + pair_forces(1:3,2)
-             
-             !***************!
-             ! stress tensor !
-             !***************!
-             
-             ! s_xx, s_yy, s_zz, s_yz, s_xz, s_xy:
-             stress(1) = stress(1) + separations(1,1) * pair_forces(1,2)
-             stress(2) = stress(2) + separations(2,1) * pair_forces(2,2)
-             stress(3) = stress(3) + separations(3,1) * pair_forces(3,2)
-             stress(4) = stress(4) + separations(2,1) * pair_forces(3,2)
-             stress(5) = stress(5) + separations(1,1) * pair_forces(3,2)
-             stress(6) = stress(6) + separations(1,1) * pair_forces(2,2)
-             
-          else if(n_targets > 2)then
+                !do index2 = 1, n_atoms
+                !   if(bo_scaling(index2))then
+                !      forces(1:3,index2) = forces(1:3,index2) - tmp_energy*bo_gradients(1:3,index2,1)
+                !   end if
+                !end do
 
-             ! If the number of targets is greater than 2,
-             ! we have found a many-body potential.
-             ! Make a note that we must also evaluate the many-body terms.
-             many_bodies_found = .true.
+                call core_add_bond_order_forces( &
+                     interaction%pot_index, index1, tmp_energy, &
+                     forces, stress )
 
-          end if ! n_targets == 2
+                ! Add the contribution of bond order gradients to the stress tensor
+                !stress(1:6) = stress(1:6) - tmp_energy*bo_virial(1:6)
 
-       end if ! is_active
-       end if ! cutoff
-    end do ! k
+                ! Add the force due to potential gradient             
+                !forces(1:3,index1) = forces(1:3,index1) + &
+                !     tmp_forces(1:3,1)*bo_factors(index1)
 
-  end subroutine core_evaluate_local_doublet_forces
+             else
 
+                 ! Add the force due to potential gradient             
+                 forces(1:3,index1) = forces(1:3,index1) + &
+                      tmp_forces(1:3,1)
+             end if
 
 
-  subroutine core_add_bond_order_forces(group_index,atom_index,&      
-       prefactor, forces, stress)
-    implicit none
-    integer, intent(in) ::group_index, atom_index
-    double precision, intent(inout) :: forces(:,:), stress(6)
-    double precision, intent(in) :: prefactor
+          case(electronegativity_evaluation_index)
 
-    type(atom) :: atom1, atom2, atom3
-    type(atom) :: atom_list(3)
-    type(neighbor_list) :: nbors1, nbors2
-    type(bond_order_parameters) :: bond_params(2)
-    integer, pointer :: bond_indices(:), bond_indices2(:)
-    integer :: index1, index2, index3, indexA, k1, k2, j, l, n_targets, n_atoms, n_level, post_process1
-    double precision :: separations(3,2), distances(2), directions(3,2), tmp_grad(3,3,3), &
-         new_grad(3,3), virial(6), total_virial(6)
-    logical :: is_active, is_in_group, many_bodies_found, separation3_unknown
+             !**********************************!
+             ! 1-body electronegativity (atom1) !
+             !**********************************!
 
-    call core_get_bond_order_sums(group_index,bo_sums)
+             ! evaluate the 1-body energy involving atom1
+             call evaluate_electronegativity(1,interaction%n_product,dummy_sep,dummy_dist,&
+                  interaction,tmp_enegs(1),atoms(index1:index1)) ! in Potentials.f90
 
-    n_atoms = size(atoms)
-    virial = 0.d0
-    total_virial = 0.d0
+             ! If there is a bond order factor associated with the potential,
+             ! we add the contribution is brings:
+             if(interaction%pot_index > -1)then
+                call core_get_bond_order_factors(interaction%pot_index,&
+                     bo_factors)
 
-    ! target atom, given as argument 
-    ! (the atom moved in differentiation or 
-    ! the atom whose factor is differentiated)
-    index1 = atom_index
-    atom1 = atoms(atom_index)
-    nbors1 = atom1%neighbor_list
-    bond_indices => atom1%bond_indices
-          
+                 ! Add the electronegativity due to potential gradient
+                 enegs(index1) = enegs(index1) + tmp_enegs(1)*bo_factors(index1)
+             else
 
-    ! Check all the bond factors that affect the atoms and see
-    ! if any of them require post processing.
-    ! If such a factor is found, the corresponding parameters
-    ! are saved to be used for the post processing.
-    ! Note that only one set of post processing parameters will
-    ! be used: the first found. This is because there may well
-    ! be several factors acting on the same type of atom and
-    ! we do not want to apply the post processing several times.
-    post_process1 = -1
-    do indexA = 1, size(bond_indices)
-       bond_params(1) = bond_factors(bond_indices(indexA))
-       call bond_order_factor_is_in_group(bond_params(1),group_index,is_in_group) ! in Potentials.f90
-       if(is_in_group)then
-          if( bond_params(1)%includes_post_processing .and. bond_params(1)%n_level == 1 )then
-             if( bond_params(1)%original_elements(1) == atom1%element )then
-                ! store the index of the parameters 
-                post_process1 = bond_indices(indexA)
-                exit
+                 ! Add the electronegativity due to potential gradient
+                 enegs(index1) = enegs(index1) + tmp_enegs(1)
              end if
-          end if
-       end if
-    end do
 
 
-    ! loop over neighbors
-    do j = 1, nbors1%n_neighbors
-       
-       ! neighboring atom
-       index2 = nbors1%neighbors(j)          
-       atom2 = atoms(index2)
-       atom_list(1) = atom1
-       atom_list(2) = atom2
+          end select
 
-       ! calculate atom1-atom2 separation vector
-       ! and distance
-       call separation_vector(atom1%position, &
-            atom2%position, &
-            nbors1%pbc_offsets(1:3,j), &
-            cell, &
-            separations(1:3,1)) ! in Geometry.f90
-       distances(1) = .norm.(separations(1:3,1))
-       if(distances(1) == 0.d0)then
-          directions(1:3,1) = (/ 0.d0, 0.d0, 0.d0 /)
-       else
-          directions(1:3,1) = separations(1:3,1) / distances(1)
        end if
-          
-       many_bodies_found = .false.
+    end do
 
-       !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
-       ! apply 2-body bond order factors !
-       !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
 
-       if(distances(1) < atom1%max_bond_radius)then
+  end subroutine core_evaluate_local_singlet
 
-          ! loop over bond order factors affecting atom1
-          do k1 = 1, size(bond_indices)
-          
-             bond_params(1) = bond_factors(bond_indices(k1))
 
-             ! filter the bond indices before applying by checking:
-             ! number of targets,
-             ! is atom2 affected by the factor,
-             ! is the factor in the correct group
-             call bond_order_factor_is_in_group(bond_params(1),group_index,is_in_group) ! in Potentials.f90
-             if( is_in_group .and. bond_params(1)%cutoff > distances(1) )then
-                call bond_order_factor_affects_atom(bond_params(1),atom2,is_active,2) ! in Potentials.f90
-                if( is_active )then
-                   call get_number_of_targets_of_bond_order_factor_index(bond_params(1)%type_index,&
-                        n_targets) ! in Potentials.f90
-                   if( n_targets == 2 )then
-                      
-                      ! evaluate the atom1-atom2 term in the bond gradient sum
-                      call evaluate_bond_order_gradient(2,&
-                           separations(1:3,1),&
-                           distances(1),&
-                           bond_params(1),&
-                           tmp_grad(1:3,1:2,1:2),&
-                           atom_list(1:2)) ! in Potentials.f90
+ 
 
 
-                      if( post_process1 > 0)then
-                         call post_process_bond_order_gradient(bo_sums(index1),&
-                              tmp_grad(1:3,1,1),&
-                              bond_factors( post_process1 ),&
-                              new_grad(1:3,1))
-                         call post_process_bond_order_gradient(bo_sums(index1),&
-                              tmp_grad(1:3,1,2),&
-                              bond_factors( post_process1 ),&
-                              new_grad(1:3,2))
-                         new_grad(1:3,1) = - prefactor*new_grad(1:3,1)
-                         new_grad(1:3,2) = - prefactor*new_grad(1:3,2)
-                      else
-                         new_grad(1:3,1) = - prefactor*tmp_grad(1:3,1,1)
-                         new_grad(1:3,2) = - prefactor*tmp_grad(1:3,1,2)
-                      end if
-                      
-                      forces(1:3,index1) = forces(1:3,index1) + new_grad(1:3,1)
-                      forces(1:3,index2) = forces(1:3,index2) + new_grad(1:3,2)
+  ! Evaluates the local potential affecting two atoms. (Rearranged internally compared to 'A'.)
+  !
+  ! *index1 index of the atom 1
+  ! *index2 index of the atom 2
+  ! *atom_doublet the atoms that are targeted
+  ! *test_index1 if 1, test if the ineraction targets atom1; similarly for 2
+  ! *interaction_indices the interactions targeting the given atoms
+  ! *separations distance vector from 1 to 2, as an array
+  ! *directions unit vector from 1 to 2, as an array
+  ! *distances distance from 1 to 2, as an array
+  ! *energy calculated energy
+  ! *many_bodies_found returns true if the loop finds an interaction with 3 or more targets
+  ! *manybody_indices the indices of the found interactions with 3 or more targets
+  ! *n_manybody the number of found interactions with 3 or more targets
+  ! *skip_pairs optional logical tag; if true, the 2-body interactions are not evaluated and only the many-body interactions are listed
+  subroutine core_evaluate_local_doublet_energy_B(atom_doublet, &
+       index1, index2, &
+       test_index1, &
+       interaction_indices, &
+       separations, directions, distances, &
+       energy, &
+       many_bodies_found, &
+       manybody_indices, &
+       n_manybody, &
+       skip_pairs)
+    implicit none
+    integer, intent(in) :: index1, index2, test_index1
+    integer, intent(out) :: n_manybody
+    integer, pointer :: interaction_indices(:), manybody_indices(:)
+    double precision, intent(inout) :: energy
+    type(atom), intent(in) :: atom_doublet(2)
+    double precision, intent(in) :: separations(3,1), directions(3,1), distances(1)
+    logical, intent(out) :: many_bodies_found
+    logical, optional, intent(in) :: skip_pairs
+    
+    type(atom) :: atom1, atom2
+    integer :: k, n_targets, index_pair(2)
+    type(potential) :: interaction
+    double precision :: &
+         tmp_energy, &
+         cut_factors(1), pair_bo_factors(2), pair_bo_sums(2)
+    logical :: is_active, evaluate_pairs
 
-                      !temp_gradient(1:3,index1,1) = temp_gradient(1:3,index1,1) + tmp_grad(1:3,1,1)
-                      !temp_gradient(1:3,index2,1) = temp_gradient(1:3,index2,1) + tmp_grad(1:3,1,2)
-                      
-                      ! virial: r_a*f_b (xx, yy, zz, yz, xz, xy)
-                      virial(1) = virial(1) + separations(1,1) * tmp_grad(1,1,2)
-                      virial(2) = virial(2) + separations(2,1) * tmp_grad(2,1,2)
-                      virial(3) = virial(3) + separations(3,1) * tmp_grad(3,1,2)
-                      virial(4) = virial(4) + separations(2,1) * tmp_grad(3,1,2)
-                      virial(5) = virial(5) + separations(1,1) * tmp_grad(3,1,2)
-                      virial(6) = virial(6) + separations(1,1) * tmp_grad(2,1,2)
-                      
-                   else if( n_targets > 2 )then
-                      
-                      ! If the number of targets is greater than 2,
-                      ! we have found a many-body bond order factor.
-                      ! Make a note that we must also evaluate the many-body factors.
+    evaluate_pairs = .true.
+    if(present(skip_pairs))then
+       evaluate_pairs = .not.skip_pairs
+    end if
+    many_bodies_found = .false.
+    n_manybody = 0
+    atom1 = atom_doublet(1)
+    atom2 = atom_doublet(2)
+    index_pair = (/ index1, index2 /)
 
-                      ! many bodies are only relevant for per-atom factors here
-                      call get_level_of_bond_order_factor_index(bond_params(1)%type_index, n_level)
-                      if(n_level == 1)then
-                         many_bodies_found = .true.
-                      end if
+    ! loop over potentials affecting atom1
+    do k = 1, size(interaction_indices)
 
-                   end if ! n_targets == 2
-                end if ! is_active
-             end if ! is_in_group
-             
-          end do ! k1 = 1, size(bond_indices)
-       end if ! distance < max_cut
-    end do ! j
+       interaction = interactions(interaction_indices(k))
 
-    if( many_bodies_found )then
-          write(*,*) " **** The many-body per-atom bond order factors are currently turned off, **** "
-          write(*,*) " **** since only the slow debug version has been implemented.             **** "
-          call exit(1)
-    end if
+       ! filter the potentials by:
+       ! is atom2 affected by the potential,
+       ! is it a 2-body potential
+       if( interaction%cutoff > distances(1) )then 
+          call potential_affects_atom(interaction,atom_doublet(test_index1),is_active,2) ! in Potentials.f90
+          if( is_active )then 
+             call get_number_of_targets_of_potential_index(interaction%type_index,&
+                  n_targets) ! in Potentials.f90
+             if( n_targets == 2 .and. .not.evaluate_pairs )then
+                ! only the many-body interactions are needed
+                cycle
+             end if
+             if( n_targets == 2 )then
+                
+                
+                !*****************************!
+                ! 2-body energy (atom1-atom2) !
+                !*****************************!
 
-    ! Post process the virial in two batches
-    ! The scaling function is the same as for the
-    ! gradient itself
-    if( post_process1 > 0 )then
-       call post_process_bond_order_gradient(bo_sums(index1),&
-            virial(1:3),&
-            bond_factors( post_process1 ),&
-            total_virial(1:3))
-       call post_process_bond_order_gradient(bo_sums(index1),&
-            virial(4:6),&
-            bond_factors( post_process1 ),&
-            total_virial(4:6))
-    else
-       total_virial = virial
-    end if
+                ! If there is a bond order factor associated with the potential,
+                ! we add the contribution is brings:
+                !
+                ! V = \sum_ij b_ij v_ij
+                ! b_ij = (b_i + b_j) / 2 + B_ij
+                if(interaction%pot_index > -1)then
+                   ! get b_i (for all i, they have been precalculated)
+                   ! call core_get_bond_order_factors(n_atoms,&
+                   !     interaction%pot_index,&
+                   !     bo_factors)
 
-    ! Add the contribution of bond order gradients to the stress tensor
-    stress(1:6) = stress(1:6) - prefactor * total_virial(1:6)
 
-  end subroutine core_add_bond_order_forces
+                   ! get B_ij for this ij (not precalculated)
+                   ! this is 
+                   ! B_ij = (B*_ij + B*_ji) / 2
+                   call core_calculate_pair_bond_order_factor(index_pair, &
+                        separations(1:3,1), distances(1), directions(1:3,1), &
+                        interaction%pot_index, &
+                        pair_bo_sums(1:2))
+                   call core_post_process_pair_bond_order_factor(atom1, &
+                        interaction%pot_index, &
+                        pair_bo_sums(1), &
+                        pair_bo_factors(1))
+                   call core_post_process_pair_bond_order_factor(atom2, &
+                        interaction%pot_index, &
+                        pair_bo_sums(2), &
+                        pair_bo_factors(2))
+                        
+                else
+
+                end if
+
+                ! If a smooth cutoff is present, we add the
+                ! contribution it brings:
+                ! 
+                ! V = \sum_ij v_ij f(r_ij)
+                if(interaction%smoothened)then
+                   ! get f(r_ij)
+                   call smoothening_factor(distances(1),&
+                        interaction%cutoff,interaction%soft_cutoff,&
+                        cut_factors(1)) ! in Potentials.f90
+                else
+                   cut_factors(1) = 1.d0
+                end if
+
+                ! evaluate the 2-body energy involving atom1-atom2 interaction
+                call evaluate_energy(2,interaction%n_product,separations(1:3,1),distances(1),&
+                     interaction,tmp_energy,atom_doublet)  ! in Potentials.f90
+
+                    
+                ! add the term: b_ij v_ij f(rij)
+                if(interaction%pot_index > -1)then
+                    energy = energy + tmp_energy*cut_factors(1)*&
+                         (saved_bond_order_factors(index1,group_index_save_slot(interaction%pot_index))+&
+                         saved_bond_order_factors(index2,group_index_save_slot(interaction%pot_index))+&
+                         pair_bo_factors(1)+pair_bo_factors(2))*0.5d0
+
+                else
+                    energy = energy + tmp_energy*cut_factors(1)
+                end if
 
+          else if(n_targets > 2)then
 
+             ! If the number of targets is greater than 2,
+             ! we have found a many-body potential.
+             ! Make a note that we must also evaluate the many-body terms.
+             many_bodies_found = .true.
+             n_manybody = n_manybody + 1
+             manybody_indices(n_manybody) = interaction_indices(k)
 
+          end if ! n_targets == 2
 
-  ! Evaluates the local force affecting two atoms from bond order factors.
+       end if ! is_active
+       end if ! cutoff
+    end do ! k
+
+  end subroutine core_evaluate_local_doublet_energy_B
+
+
+
+  ! Evaluates the local potential affecting two atoms.
   !
-  ! *n_atoms total number of atoms in the system
   ! *index1 index of the atom 1
   ! *index2 index of the atom 2
   ! *atom_doublet the atoms that are targeted
   ! *test_index1 if 1, test if the ineraction targets atom1; similarly for 2
-  ! *interaction the interactions targeting the given atoms
+  ! *interaction_indices the interactions targeting the given atoms
   ! *separations distance vector from 1 to 2, as an array
   ! *directions unit vector from 1 to 2, as an array
   ! *distances distance from 1 to 2, as an array
-  ! *forces calculated forces
-  ! *stress calculated stress
+  ! *energy calculated energy
   ! *many_bodies_found returns true if the loop finds an interaction with 3 or more targets
-  subroutine core_add_pair_bond_order_forces(  &
-       !atom_doublet, &
+  subroutine core_evaluate_local_doublet_energy(n_atoms, &
+       atom_doublet, &
        index1, index2, &
-       interaction, prefactor, &
-       separation, direction, distance, &
-       group_index, pair_bo_sums, pair_bo_factors, &
-       forces, stress )
+       test_index1, &
+       interaction_indices, &
+       separations, directions, distances, &
+       energy, &
+       many_bodies_found)
     implicit none
-    integer, intent(in) :: index1, index2, group_index
-    double precision, intent(inout) :: forces(:,:), stress(6)
-    !type(atom), intent(in) :: atom_doublet(2)
-    double precision, intent(in) :: separation(3), direction(3), distance, &
-         prefactor, pair_bo_factors(2), pair_bo_sums(2)
+    integer, intent(in) :: n_atoms, index1, index2, test_index1
+    integer, pointer :: interaction_indices(:)
+    double precision, intent(inout) :: energy
+    type(atom), intent(in) :: atom_doublet(2)
+    double precision, intent(in) :: separations(3,1), directions(3,1), distances(1)
+    logical, intent(out) :: many_bodies_found
     
-    integer :: i,j,k,k1,l, index3, n_targets, index_pair(2), n_atoms, offset(3), &
-         post_process1, post_process2, indexA
+    type(atom) :: atom1, atom2
+    integer :: k, n_targets, index_pair(2)
     type(potential) :: interaction
-    type(bond_order_parameters) :: bond_params
-    double precision :: &
-         separations(3,2), directions(3,2), distances(2), &
-         tmp_energy, tmp_grad(3,3), new_grad(3,3), tmp_forces(3,2), &
-         virial(6,2), total_virial(6,2), dummy_grad(3,2), process_factor(2)
+    double precision :: bo_factors(n_atoms), bo_sums(n_atoms), &
+         tmp_energy, &
+         cut_factors(1), pair_bo_factors(2), pair_bo_sums(2)
+    logical :: is_active
 
-    logical :: is_active, is_in_group
-    integer, pointer :: bond_indices(:), bond_indices2(:)
+    many_bodies_found = .false.
+    atom1 = atom_doublet(1)
+    atom2 = atom_doublet(2)
+    index_pair = (/ index1, index2 /)
 
-    type(atom) :: atom1, atom2, atom3
-    type(atom) :: atom_list(3)
-    type(neighbor_list) :: nbors1, nbors2
+    ! loop over potentials affecting atom1
+    do k = 1, size(interaction_indices)
 
+       interaction = interactions(interaction_indices(k))
 
-    n_atoms = size(atoms)
-    !atom1 = atom_doublet(1)
-    !atom2 = atom_doublet(2)
-    index_pair = (/ index1, index2 /)
+       ! filter the potentials by:
+       ! is atom2 affected by the potential,
+       ! is it a 2-body potential
+       if( interaction%cutoff > distances(1) )then 
+       call potential_affects_atom(interaction,atom_doublet(test_index1),is_active,2) ! in Potentials.f90
+       if( is_active )then 
+          call get_number_of_targets_of_potential_index(interaction%type_index,&
+               n_targets) ! in Potentials.f90
+          if( n_targets == 2 )then
 
-    ! target atom 1
-    atom1 = atoms(index1)
-    nbors1 = atom1%neighbor_list
-    bond_indices => atom1%bond_indices
 
-    ! target atom 2
-    atom2 = atoms(index2)
-    nbors2 = atom2%neighbor_list
-    bond_indices2 => atom2%bond_indices
-    virial = 0.d0
+                !*****************************!
+                ! 2-body energy (atom1-atom2) !
+                !*****************************!
 
+                ! If there is a bond order factor associated with the potential,
+                ! we add the contribution is brings:
+                !
+                ! V = \sum_ij b_ij v_ij
+                ! b_ij = (b_i + b_j) / 2 + B_ij
+                if(interaction%pot_index > -1)then
+                   ! get b_i (for all i, they have been precalculated)
+                   call core_get_bond_order_factors(interaction%pot_index,&
+                        bo_factors)
 
-    ! Check all the bond factors that affect the atoms and see
-    ! if any of them require post processing.
-    ! If such a factor is found, the corresponding parameters
-    ! are saved to be used for the post processing.
-    ! Note that only one set of post processing parameters will
-    ! be used: the first found. This is because there may well
-    ! be several factors acting on the same type of atom and
-    ! we do not want to apply the post processing several times.
-    post_process1 = -1
-    do indexA = 1, size(bond_indices)
-       bond_params = bond_factors(bond_indices(indexA))
-       call bond_order_factor_is_in_group(bond_params,group_index,is_in_group) ! in Potentials.f90
-       if(is_in_group)then
-          if( bond_params%includes_post_processing .and. bond_params%n_level == 2 )then
-             if( bond_params%original_elements(1) == atom1%element )then
-                ! store the index of the parameters 
-                post_process1 = bond_indices(indexA)
-                dummy_grad = 1.d0
-                call post_process_bond_order_gradient(pair_bo_sums(1), &
-                     dummy_grad(1:3,1), &
-                     bond_params, &
-                     dummy_grad(1:3,2) ) ! in Potentials.f90
-                process_factor(1) = dummy_grad(1,2)
-                exit
-             end if
-          end if
-       end if
-    end do
+                   ! get B_ij for this ij (not precalculated)
+                   ! this is 
+                   ! B_ij = (B*_ij + B*_ji) / 2
+                   call core_calculate_pair_bond_order_factor(index_pair, &
+                        separations(1:3,1), distances(1), directions(1:3,1), &
+                        interaction%pot_index, &
+                        pair_bo_sums(1:2))
+                   call core_post_process_pair_bond_order_factor(atom1, &
+                        interaction%pot_index, &
+                        pair_bo_sums(1), &
+                        pair_bo_factors(1))
+                   call core_post_process_pair_bond_order_factor(atom2, &
+                        interaction%pot_index, &
+                        pair_bo_sums(2), &
+                        pair_bo_factors(2))
 
-    post_process2 = -1
-    do indexA = 1, size(bond_indices2)
-       bond_params = bond_factors(bond_indices2(indexA))
-       call bond_order_factor_is_in_group(bond_params,group_index,is_in_group) ! in Potentials.f90
-       if(is_in_group)then
-          if( bond_params%includes_post_processing .and. bond_params%n_level == 2 )then
-             if( bond_params%original_elements(1) == atom2%element )then
-                ! store the index of the parameters 
-                post_process2 = bond_indices2(indexA)
-                dummy_grad = 1.d0
-                call post_process_bond_order_gradient(pair_bo_sums(2), &
-                     dummy_grad(1:3,1), &
-                     bond_params, &
-                     dummy_grad(1:3,2) ) ! in Potentials.f90
-                process_factor(2) = dummy_grad(1,2)
-                exit
-             end if
-          end if
-       end if
-    end do
+                else
+                   !bo_factors = 1.d0
+                end if
 
-    ! In the 3-body loop, we search the neighbors of both atom1
-    ! and atom2 to find the triplets 
-    ! atom1-atom2-atom3 and
-    ! atom2-atom1-atom3
-    ! These are considered to be different, since the middle atom of
-    ! the triplet is different (atom2 vs. atom1).
-    
-    ! First we try to find ordered triplets atom2 -- atom1 -- atom3
-    ! Therefore we need separations a2--a1 and a1--a3.
+                ! If a smooth cutoff is present, we add the
+                ! contribution it brings:
+                ! 
+                ! V = \sum_ij v_ij f(r_ij)
+                if(interaction%smoothened)then
+                   ! get f(r_ij)
+                   call smoothening_factor(distances(1),&
+                        interaction%cutoff,interaction%soft_cutoff,&
+                        cut_factors(1)) ! in Potentials.f90
+                else
+                   cut_factors(1) = 1.d0
+                end if
 
-    ! atom2 - atom1 vector
-    separations(1:3,1) = -separation(1:3)
-    distances(1) = distance
-    directions(1:3,1) = -direction(1:3)
-        
+                ! evaluate the 2-body energy involving atom1-atom2 interaction
+                call evaluate_energy(2,interaction%n_product,separations(1:3,1),distances(1),&
+                     interaction,tmp_energy,atom_doublet)  ! in Potentials.f90
 
-    ! loop over neighbors of atom 1
-    do j = 1, nbors1%n_neighbors
-       
-       ! neighboring atom
-       index3 = nbors1%neighbors(j)
-       offset(1:3) = nbors1%pbc_offsets(1:3,j)
-       
-       atom3 = atoms(index3)
-       atom_list = (/ atom2, atom1, atom3 /)
-       
-       ! calculate atom1-atom3 separation vector
-       ! and distance
-       call separation_vector(atom1%position, &
-            atom3%position, &
-            offset(1:3), &
-            cell, &
-            separations(1:3,2)) ! in Geometry.f90
-       distances(2) = .norm.(separations(1:3,2))
-       if(distances(2) == 0.d0)then
-          directions(1:3,2) = (/ 0.d0, 0.d0, 0.d0 /)
-       else
-          directions(1:3,2) = separations(1:3,2) / distances(2)
-       end if
-       
-       ! To prevent the case index2 - index1 - index2
-       if(any(separations(1:3,1)+separations(1:3,2) /= 0.d0))then
-   
-          !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
-          ! apply 3-body bond order factors !
-          !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
+                ! add the term: b_ij v_ij f(rij)
+                if(interaction%pot_index > -1)then
+                    energy = energy + tmp_energy*cut_factors(1)*&
+                         (bo_factors(index1)+bo_factors(index2)+pair_bo_factors(1)+pair_bo_factors(2))*0.5d0
+                else
+                    energy = energy + tmp_energy*cut_factors(1)
+                end if
 
-          if(distances(2) < atom1%max_bond_radius)then
+          else if(n_targets > 2)then
 
-             ! search for the first bond params containing the parameters for (atom2-atom1) -- atom3
-             do k1 = 1, size(bond_indices)
-                
-                bond_params = bond_factors(bond_indices(k1))
-                
-                ! filter the parameters by:
-                ! number of targets, atom2 and atom3 being targets, group index                   
-                call bond_order_factor_is_in_group(bond_params,&
-                     group_index,is_in_group) ! in Potentials.f90
-                            
-                if( is_in_group )then
-                   call bond_order_factor_affects_atom(bond_params,&
-                        atom2,is_active,2) ! in Potentials.f90
-                   if( is_active )then
-                      call get_number_of_targets_of_bond_order_factor_index(bond_params%type_index,&
-                           n_targets) ! in Potentials.f90
-                      if( n_targets == 3 )then
-                         call bond_order_factor_affects_atom(bond_params,&
-                              atom3,is_active,3) ! in Potentials.f90
-                         if( is_active )then
-                            
-                            
-                            ! Evaluate the atom2-atom1-atom3 triplet contribution
-                            ! in the bond gradient sum.
-                            ! The gradient is stored in tmp_grad whose indices are
-                            ! (xyz, factor index, moved atom index)
-                            call evaluate_pair_bond_order_gradient(3,&
-                                 separations(1:3,1:2),&
-                                 distances(1:2),&
-                                 bond_params,&
-                                 tmp_grad(1:3,1:3),&
-                                 atom_list) ! in Potentials.f90
-                            
-               
-                            if( post_process1 > 0)then
-!!$                               call post_process_bond_order_gradient(pair_bo_sums(1),&
-!!$                                    tmp_grad(1:3,1),&
-!!$                                    bond_factors( post_process1 ),&
-!!$                                    new_grad(1:3,1))
-!!$                               call post_process_bond_order_gradient(pair_bo_sums(1),&
-!!$                                    tmp_grad(1:3,2),&
-!!$                                    bond_factors( post_process1 ),&
-!!$                                    new_grad(1:3,2))
-!!$                               call post_process_bond_order_gradient(pair_bo_sums(1),&
-!!$                                    tmp_grad(1:3,3),&
-!!$                                    bond_factors( post_process1 ),&
-!!$                                    new_grad(1:3,3))
-                               new_grad(1:3,1:3) = - process_factor(1)*prefactor*tmp_grad(1:3,1:3)
-                            else
-                               new_grad(1:3,1:3) = - prefactor*tmp_grad(1:3,1:3)
-                            end if
- 
-                            ! store the gradients of the pair bond factor
-                            ! with respect to moving atom1, atom2, atom3
-                            ! The triplet is atom2-atom1-atom3, so index2 gets the first
-                            ! entry in the second column of tmp_grad.
-                            forces(1:3,index2) = forces(1:3,index2) + new_grad(1:3,1)
-                            forces(1:3,index1) = forces(1:3,index1) + new_grad(1:3,2)
-                            forces(1:3,index3) = forces(1:3,index3) + new_grad(1:3,3)
+             ! If the number of targets is greater than 2,
+             ! we have found a many-body potential.
+             ! Make a note that we must also evaluate the many-body terms.
+             many_bodies_found = .true.
 
-                            ! virial: r_a*f_b (xx, yy, zz, yz, xz, xy) 
-                            ! r from atom1 to other atoms - now atom1 is center atom
-                            virial(1,1) = virial(1,1) - separations(1,1) * tmp_grad(1,1) & ! r_12*f2
-                                 + separations(1,2) * tmp_grad(1,3)   ! r_13*f3
-                            virial(2,1) = virial(2,1) - separations(2,1) * tmp_grad(2,1) & ! r_12*f2
-                                 + separations(2,2) * tmp_grad(2,3)   ! r_13*f3
-                            virial(3,1) = virial(3,1) - separations(3,1) * tmp_grad(3,1) & ! r_12*f2
-                                 + separations(3,2) * tmp_grad(3,3)   ! r_13*f3
-                            virial(4,1) = virial(4,1) - separations(2,1) * tmp_grad(3,1) & ! r_12*f2
-                                 + separations(2,2) * tmp_grad(3,3)   ! r_13*f3
-                            virial(5,1) = virial(5,1) - separations(1,1) * tmp_grad(3,1) & ! r_12*f2
-                                 + separations(1,2) * tmp_grad(3,3)   ! r_13*f3
-                            virial(6,1) = virial(6,1) - separations(1,1) * tmp_grad(2,1) & ! r_12*f2
-                                 + separations(1,2) * tmp_grad(2,3)   ! r_13*f3
-                            
-                         end if ! is_active
-                      end if ! n_targets == 3
-                   end if ! is_active
-                end if ! is_in_group
-             end do ! k1
-          end if ! distance < max_cut
-       end if ! index3 /= index2
+          end if ! n_targets == 2
 
-    end do ! j = 1, nbors1%n_neighbors
+       end if ! is_active
+       end if ! cutoff
+    end do ! k
 
-
-    ! Next we try to find ordered triplets atom1 -- atom2 -- atom3
-    ! Therefore we need separations a1--a2 and a2--a3.
-    separations(1:3,1) = -separations(1:3,1)
-    directions(1:3,1) = -directions(1:3,1)
-
-    ! loop over neighbors of atom 2
-    do j = 1, nbors2%n_neighbors
-       
-       ! neighboring atom
-       index3 = nbors2%neighbors(j)
-       offset(1:3) = nbors2%pbc_offsets(1:3,j)
-
-       atom3 = atoms(index3)
-       atom_list = (/ atom1, atom2, atom3 /)
-       
-       ! calculate atom2-atom3 separation vector
-       ! and distance
-       call separation_vector(atom2%position, &
-            atom3%position, &
-            offset(1:3), &
-            cell, &
-            separations(1:3,2)) ! in Geometry.f90
-       distances(2) = .norm.(separations(1:3,2))
-       if(distances(2) == 0.d0)then
-          directions(1:3,2) = (/ 0.d0, 0.d0, 0.d0 /)
-       else
-          directions(1:3,2) = separations(1:3,2) / distances(2)
-       end if
-       
-       ! To prevent the case index2 - index1 - index2
-       if(any(separations(1:3,1)+separations(1:3,2) /= 0.d0))then
-
-          !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
-          ! apply 3-body bond order factors !
-          !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
-
-          if(distances(2) < atom2%max_bond_radius)then
-
-             ! search for the bond params containing the parameters for (atom1-atom2) -- atom3
-             do k1 = 1, size(bond_indices2)
-                
-                bond_params = bond_factors(bond_indices2(k1))
-                
-                ! filter the parameters by:
-                ! number of targets, atom2 and atom3 being targets, group index                   
-                call bond_order_factor_is_in_group(bond_params,&
-                     group_index,is_in_group) ! in Potentials.f90
-                
-                if( is_in_group )then
-                   call bond_order_factor_affects_atom(bond_params,&
-                        atom1,is_active,2) ! in Potentials.f90
-                   if( is_active )then
-                      call get_number_of_targets_of_bond_order_factor_index(bond_params%type_index,&
-                           n_targets) ! in Potentials.f90
-                      if( n_targets == 3 )then
-                         call bond_order_factor_affects_atom(bond_params,&
-                              atom3,is_active,3) ! in Potentials.f90
-                         if( is_active )then            
-                            
-                            ! Evaluate the atom2-atom1-atom3 triplet contribution
-                            ! in the bond gradient sum.
-                            ! The gradient is stored in tmp_grad whose indices are
-                            ! (xyz, factor index, moved atom index)
-                            call evaluate_pair_bond_order_gradient(3,&
-                                 separations(1:3,1:2),&
-                                 distances(1:2),&
-                                 bond_params,&
-                                 tmp_grad(1:3,1:3),&
-                                 atom_list) ! in Potentials.f90
-                                                        
-                            if( post_process2 > 0)then                               
-!!$                               call post_process_bond_order_gradient(pair_bo_sums(2),&
-!!$                                    tmp_grad(1:3,1),&
-!!$                                    bond_factors( post_process2 ),&
-!!$                                    new_grad(1:3,1))
-!!$                               call post_process_bond_order_gradient(pair_bo_sums(2),&
-!!$                                    tmp_grad(1:3,2),&
-!!$                                    bond_factors( post_process2 ),&
-!!$                                    new_grad(1:3,2))
-!!$                               call post_process_bond_order_gradient(pair_bo_sums(2),&
-!!$                                    tmp_grad(1:3,3),&
-!!$                                    bond_factors( post_process2 ),&
-!!$                                    new_grad(1:3,3))
-!!$                               new_grad(1:3,1) = - prefactor*new_grad(1:3,1)
-!!$                               new_grad(1:3,2) = - prefactor*new_grad(1:3,2)
-!!$                               new_grad(1:3,3) = - prefactor*new_grad(1:3,3)
-                               new_grad(1:3,1:3) = - process_factor(2)*prefactor*tmp_grad(1:3,1:3)
-                            else
-                               new_grad(1:3,1) = - prefactor*tmp_grad(1:3,1)
-                               new_grad(1:3,2) = - prefactor*tmp_grad(1:3,2)
-                               new_grad(1:3,3) = - prefactor*tmp_grad(1:3,3)
-                            end if
-
-
-                            ! store the gradients of the pair bond factor
-                            ! with respect to moving atom1, atom2, atom3
-                            ! The triplet is atom1-atom2-atom3, so index1 gets the first
-                            ! entry in the second column of tmp_grad.                            
-                            forces(1:3,index1) = forces(1:3,index1) + new_grad(1:3,1)
-                            forces(1:3,index2) = forces(1:3,index2) + new_grad(1:3,2)
-                            forces(1:3,index3) = forces(1:3,index3) + new_grad(1:3,3)
-
-                            ! virial: r_a*f_b (xx, yy, zz, yz, xz, xy) 
-                            ! r from atom1 to other atoms - now atom1 is center atom
-                            virial(1,2) = virial(1,2) - separations(1,1) * tmp_grad(1,1) & ! r_12*f2
-                                 + separations(1,2) * tmp_grad(1,3)   ! r_13*f3
-                            virial(2,2) = virial(2,2) - separations(2,1) * tmp_grad(2,1) & ! r_12*f2
-                                 + separations(2,2) * tmp_grad(2,3)   ! r_13*f3
-                            virial(3,2) = virial(3,2) - separations(3,1) * tmp_grad(3,1) & ! r_12*f2
-                                 + separations(3,2) * tmp_grad(3,3)   ! r_13*f3
-                            virial(4,2) = virial(4,2) - separations(2,1) * tmp_grad(3,1) & ! r_12*f2
-                                 + separations(2,2) * tmp_grad(3,3)   ! r_13*f3
-                            virial(5,2) = virial(5,2) - separations(1,1) * tmp_grad(3,1) & ! r_12*f2
-                                 + separations(1,2) * tmp_grad(3,3)   ! r_13*f3
-                            virial(6,2) = virial(6,2) - separations(1,1) * tmp_grad(2,1) & ! r_12*f2
-                                 + separations(1,2) * tmp_grad(2,3)   ! r_13*f3
-                            
-                         end if ! is_active
-                      end if ! n_targets == 3
-                   end if ! is_active
-                end if ! is_in_group
-             end do ! k1
-          end if ! distance < max_cut
-       end if ! index3 /= index1
-
-    end do ! j = 1, nbors2%n_neighbors
-
-
-    ! Post process the virial in two batches
-    ! The scaling function is the same as for the
-    ! gradient itself
-    if( post_process1 > 0 )then
-
-       call post_process_bond_order_gradient(pair_bo_sums(1), &
-            virial(1:3,1), &
-            bond_factors( post_process1 ), &
-            total_virial(1:3,1) ) ! in Potentials.f90
-       call post_process_bond_order_gradient(pair_bo_sums(1), &
-            virial(4:6,1), &
-            bond_factors( post_process1 ), &
-            total_virial(4:6,1) ) ! in Potentials.f90
-
-    else
-
-       total_virial(1:6,1) = virial(1:6,1)
-
-    end if
-
-    if( post_process2 > 0 )then
-
-       call post_process_bond_order_gradient(pair_bo_sums(2), &
-            virial(1:3,2), &
-            bond_factors( post_process2 ), &
-            total_virial(1:3,2) ) ! in Potentials.f90
-       call post_process_bond_order_gradient(pair_bo_sums(2), &
-            virial(4:6,2), &
-            bond_factors( post_process2 ), &
-            total_virial(4:6,2) ) ! in Potentials.f90
-    else
-
-       total_virial(1:6,2) = virial(1:6,2)
-
-    end if
-
-    ! Add the contribution of bond order gradients to the stress tensor
-    stress(1:6) = stress(1:6) - prefactor * ( total_virial(1:6,1) + total_virial(1:6,2) )
-
-
-  end subroutine core_add_pair_bond_order_forces
+  end subroutine core_evaluate_local_doublet_energy
 
 
 
-  ! Evaluates the local force affecting two atoms. (Rearranged internally.)
+  ! Evaluates the local force affecting two atoms.
   !
   ! *n_atoms total number of atoms in the system
   ! *index1 index of the atom 1
   ! *index2 index of the atom 2
   ! *atom_doublet the atoms that are targeted
-  ! *test_index1 if 1, test if the interaction targets atom1; similarly for 2
+  ! *test_index1 if 1, test if the ineraction targets atom1; similarly for 2
   ! *interaction_indices the interactions targeting the given atoms
   ! *separations distance vector from 1 to 2, as an array
   ! *directions unit vector from 1 to 2, as an array
@@ -5368,29 +5671,26 @@ contains
   ! *forces calculated forces
   ! *stress calculated stress
   ! *many_bodies_found returns true if the loop finds an interaction with 3 or more targets
-  subroutine core_evaluate_local_doublet_forces_B( &
+  subroutine core_evaluate_local_doublet_forces(n_atoms, &
        atom_doublet, &
        index1, index2, &
        test_index1, &
        interaction_indices, &
        separations, directions, distances, &
        forces,stress, &
-       many_bodies_found, &
-       manybody_indices, &
-       n_manybody)
+       many_bodies_found)
     implicit none
-    integer, intent(in) :: index1, index2, test_index1
-    integer, intent(out) :: n_manybody
-    integer, pointer :: interaction_indices(:), manybody_indices(:)
-    double precision, intent(inout) :: forces(:,:), stress(6)
+    integer, intent(in) :: n_atoms, index1, index2, test_index1
+    integer, pointer :: interaction_indices(:)
+    double precision, intent(inout) :: forces(3,n_atoms), stress(6)
     type(atom), intent(in) :: atom_doublet(2)
     double precision, intent(in) :: separations(3,1), directions(3,1), distances(1)
     logical, intent(out) :: many_bodies_found
     
     type(atom) :: atom1, atom2
-    integer :: k, n_targets, index_pair(2), n_atoms
+    integer :: k, n_targets, index_pair(2)
     type(potential) :: interaction
-    double precision :: &
+    double precision :: bo_factors(n_atoms), bo_sums(n_atoms), bo_gradients(3,n_atoms,4), &
          tmp_energy, tmp_forces(3,2), tmp_enegs(2), &
          cut_factors(1), cut_gradients(3,1), &
          pair_forces(3,2), bo_virial(6,2), &
@@ -5398,9 +5698,7 @@ contains
          pair_bo_virial(6,2)
     logical :: is_active
 
-    n_atoms = size(atoms)
     many_bodies_found = .false.
-    n_manybody = 0
     atom1 = atom_doublet(1)
     atom2 = atom_doublet(2)
     index_pair = (/ index1, index2 /)
@@ -5467,7 +5765,23 @@ contains
              !     = - \sum_ij (\nabla_a b_ij) v_ij + b_ij f_a,ij
              !
              if(interaction%pot_index > -1)then
-
+                ! get b_i (for all i, they have been precalculated)
+                call core_get_bond_order_factors(interaction%pot_index,&
+                     bo_factors)
+                ! get (\nabla_a b_i) (for all a)
+                call core_get_bond_order_gradients(interaction%pot_index,&
+                     index1,& ! atom index
+                     1, & ! slot_index
+                     bo_gradients(1:3,1:n_atoms,1), &
+                     bo_virial(1:6,1))
+                ! get (\nabla_a b_j) (for all a)
+                call core_get_bond_order_gradients(interaction%pot_index,&
+                     index2,& ! atom index
+                     2, & ! slot_index
+                     bo_gradients(1:3,1:n_atoms,2), &
+                     bo_virial(1:6,2))
+                
+                
                 ! get B_ij and \nabla_a B_ij for this ij (not precalculated)
                 ! this is 
                 ! B_ij = (B*_ij + B*_ji) / 2
@@ -5483,67 +5797,29 @@ contains
                      interaction%pot_index, &
                      pair_bo_sums(2), &
                      pair_bo_factors(2))
-
-                ! get b_i (for all i, they have been precalculated)
-                call core_get_bond_order_factors(interaction%pot_index,&
-                     bo_factors)
                 
-                if(.false.)then ! slow debug version where all gradients are first calculated
-
-                   ! get (\nabla_a b_i) (for all a)
-                   call core_get_bond_order_gradients(interaction%pot_index,&
-                        index1,& ! atom index
-                        1, & ! slot_index
-                        bo_gradients(1:3,1:n_atoms,1), &
-                        bo_virial(1:6,1))
-                   ! get (\nabla_a b_j) (for all a)
-                   call core_get_bond_order_gradients(interaction%pot_index,&
-                        index2,& ! atom index
-                        2, & ! slot_index
-                        bo_gradients(1:3,1:n_atoms,2), &
-                        bo_virial(1:6,2))
-
-
-                   call core_calculate_pair_bond_order_gradients(index_pair, &
-                        separations(1:3,1), distances(1), directions(1:3,1), &
-                        interaction%pot_index, &                        
-                        pair_bo_sums(1:2), &
-                        bo_gradients(1:3,1:n_atoms,3:4), &
-                        pair_bo_virial(1:6,1:2))
-
-                   ! Add the bond order gradient terms involving the 
-                   ! atom1-atom2 energy for all atoms.
-                   ! That is, add the (\nabla_a b_ij) v_ij term with 
-                   ! the given ij (atom1,atom2) for all a.
-                   forces(1:3,1:n_atoms) = forces(1:3,1:n_atoms) &
-                        - tmp_energy*cut_factors(1)*&
-                        (bo_gradients(1:3,1:n_atoms,1) + bo_gradients(1:3,1:n_atoms,2) + &
-                        bo_gradients(1:3,1:n_atoms,3) + bo_gradients(1:3,1:n_atoms,4))*0.5d0
-
-                   ! Add the contribution of bond order gradients to the stress tensor
-                   stress(1:6) = stress(1:6) - tmp_energy*cut_factors(1)* &
-                        (bo_virial(1:6,1) + bo_virial(1:6,2) + pair_bo_virial(1:6,1) + pair_bo_virial(1:6,2))*0.5d0
-
-                else
-                   call core_add_bond_order_forces( &
-                        interaction%pot_index, index1, 0.5d0*tmp_energy*cut_factors(1), &
-                        forces, stress )
-
-                   call core_add_bond_order_forces( &
-                        interaction%pot_index, index2, 0.5d0*tmp_energy*cut_factors(1), &
-                        forces, stress )
-
-                   call core_add_pair_bond_order_forces( &
-                        !atom_doublet, &
-                        index1, index2, &
-                        interaction, 0.5d0*tmp_energy*cut_factors(1), &
-                        separations(1:3,1), directions(1:3,1), distances(1), &
-                        interaction%pot_index, pair_bo_sums, pair_bo_factors, &
-                        forces, stress )
-
-                end if
-
-             !else
+                call core_calculate_pair_bond_order_gradients(index_pair, &
+                     separations(1:3,1), distances(1), directions(1:3,1), &
+                     interaction%pot_index, &                        
+                     pair_bo_sums(1:2), &
+                     bo_gradients(1:3,1:n_atoms,3:4), &
+                     pair_bo_virial(1:6,1:2))
+                
+                
+                ! Add the bond order gradient terms involving the 
+                ! atom1-atom2 energy for all atoms.
+                ! That is, add the (\nabla_a b_ij) v_ij term with 
+                ! the given ij (atom1,atom2) for all a.
+                forces(1:3,1:n_atoms) = forces(1:3,1:n_atoms) &
+                     - tmp_energy*cut_factors(1)*&
+                     (bo_gradients(1:3,1:n_atoms,1) + bo_gradients(1:3,1:n_atoms,2) + &
+                     bo_gradients(1:3,1:n_atoms,3) + bo_gradients(1:3,1:n_atoms,4))*0.5d0
+                
+                ! Add the contribution of bond order gradients to the stress tensor
+                stress(1:6) = stress(1:6) - tmp_energy*cut_factors(1)* &
+                     (bo_virial(1:6,1) + bo_virial(1:6,2) + pair_bo_virial(1:6,1) + pair_bo_virial(1:6,2))*0.5d0
+                
+             else
                 !bo_factors = 1.d0
                 !bo_sums = 0.d0
                 !bo_gradients = 0.d0
@@ -5554,7 +5830,6 @@ contains
                   interaction,tmp_forces(1:3,1:2),atom_doublet) ! in Potentials.f90
              
              if(interaction%pot_index > -1)then
-
                 ! force on atom 1:                 
                 pair_forces(1:3,1) = ( tmp_forces(1:3,1) * cut_factors(1) + &
                      tmp_energy * cut_gradients(1:3,1) ) * &
@@ -5594,8 +5869,6 @@ contains
              ! we have found a many-body potential.
              ! Make a note that we must also evaluate the many-body terms.
              many_bodies_found = .true.
-             n_manybody = n_manybody + 1
-             manybody_indices(n_manybody) = interaction_indices(k)
 
           end if ! n_targets == 2
 
@@ -5603,2681 +5876,5511 @@ contains
        end if ! cutoff
     end do ! k
 
-  end subroutine core_evaluate_local_doublet_forces_B
+  end subroutine core_evaluate_local_doublet_forces
 
 
 
-  ! Evaluates the local electronegativity affecting two atoms. (Rearranged internally.)
-  !
-  ! *index1 index of the atom 1
-  ! *index2 index of the atom 2
-  ! *atom_doublet the atoms that are targeted
-  ! *test_index1 if 1, test if the ineraction targets atom1; similarly for 2
-  ! *interaction_indices the interactions targeting the given atoms
-  ! *separations distance vector from 1 to 2, as an array
-  ! *directions unit vector from 1 to 2, as an array
-  ! *distances distance from 1 to 2, as an array
-  ! *enegs calculated electronegativities
-  ! *many_bodies_found returns true if the loop finds an interaction with 3 or more targets
-  subroutine core_evaluate_local_doublet_electronegativities_B(atom_doublet, &
-       index1, index2, &
-       test_index1, &
-       interaction_indices, &
-       separations, directions, distances, &
-       enegs, &
-       many_bodies_found, &
-       manybody_indices, &
-       n_manybody)
+  subroutine core_add_bond_order_forces(group_index,atom_index,&      
+       prefactor, forces, stress)
     implicit none
-    integer, intent(in) :: index1, index2, test_index1
-    integer, intent(out) :: n_manybody
-    integer, pointer :: interaction_indices(:), manybody_indices(:)
-    double precision, intent(inout) :: enegs(:)
-    type(atom), intent(in) :: atom_doublet(2)
-    double precision, intent(in) :: separations(3,1), directions(3,1), distances(1)
-    logical, intent(out) :: many_bodies_found
-    
-    type(atom) :: atom1, atom2
-    integer :: k, n_targets, index_pair(2), n_atoms
-    type(potential) :: interaction
-    double precision :: tmp_energy, tmp_forces(3,2), tmp_enegs(2), &
-         cut_factors(1), &
-         pair_forces(3,2), bo_virial(6,2), &
-         pair_bo_sums(2), pair_bo_factors(2)
-    logical :: is_active
+    integer, intent(in) ::group_index, atom_index
+    double precision, intent(inout) :: forces(:,:), stress(6)
+    double precision, intent(in) :: prefactor
 
-    n_atoms = size(atoms)
-    many_bodies_found = .false.
-    n_manybody = 0
+    type(atom) :: atom1, atom2, atom3
+    type(atom) :: atom_list(3)
+    type(neighbor_list) :: nbors1, nbors2
+    type(bond_order_parameters) :: bond_params(2)
+    integer, pointer :: bond_indices(:), bond_indices2(:)
+    integer :: index1, index2, index3, indexA, k1, k2, j, l, n_targets, n_atoms, n_level, post_process1
+    double precision :: separations(3,2), distances(2), directions(3,2), tmp_grad(3,3,3), &
+         new_grad(3,3), virial(6), total_virial(6)
+    logical :: is_active, is_in_group, many_bodies_found, separation3_unknown
 
-    atom1 = atom_doublet(1)
-    atom2 = atom_doublet(2)
-    index_pair = (/ index1, index2 /)
+    call core_get_bond_order_sums(group_index,bo_sums)
 
-    ! loop over potentials affecting atom1
-    do k = 1, size(interaction_indices)
+    n_atoms = size(atoms)
+    virial = 0.d0
+    total_virial = 0.d0
 
-       interaction = interactions(interaction_indices(k))
+    ! target atom, given as argument 
+    ! (the atom moved in differentiation or 
+    ! the atom whose factor is differentiated)
+    index1 = atom_index
+    atom1 = atoms(atom_index)
+    nbors1 = atom1%neighbor_list
+    bond_indices => atom1%bond_indices
+          
 
-       ! filter the potentials by:
-       ! is atom2 affected by the potential,
-       ! is it a 2-body potential
-       if( interaction%cutoff > distances(1) )then 
-          call potential_affects_atom(interaction,atom_doublet(test_index1),is_active,2) ! in Potentials.f90
-          if( is_active )then 
-             call get_number_of_targets_of_potential_index(interaction%type_index,&
-                  n_targets) ! in Potentials.f90
-             if( n_targets == 2 )then
+    ! Check all the bond factors that affect the atoms and see
+    ! if any of them require post processing.
+    ! If such a factor is found, the corresponding parameters
+    ! are saved to be used for the post processing.
+    ! Note that only one set of post processing parameters will
+    ! be used: the first found. This is because there may well
+    ! be several factors acting on the same type of atom and
+    ! we do not want to apply the post processing several times.
+    post_process1 = -1
+    do indexA = 1, size(bond_indices)
+       bond_params(1) = bond_factors(bond_indices(indexA))
+       call bond_order_factor_is_in_group(bond_params(1),group_index,is_in_group) ! in Potentials.f90
+       if(is_in_group)then
+          if( bond_params(1)%includes_post_processing .and. bond_params(1)%n_level == 1 )then
+             if( bond_params(1)%original_elements(1) == atom1%element )then
+                ! store the index of the parameters 
+                post_process1 = bond_indices(indexA)
+                exit
+             end if
+          end if
+       end if
+    end do
 
 
-                !****************************************!
-                ! 2-body electronegativity (atom1-atom2) !
-                !****************************************!
+    ! the atom may have no neighbors within the cutoff
+    many_bodies_found = .false.
 
-                ! If a smooth cutoff is present, we add the
-                ! contribution it brings:
-                if(interaction%smoothened)then
-                   ! get f(r_ij)
-                   call smoothening_factor(distances(1),&
-                        interaction%cutoff,interaction%soft_cutoff,&
-                        cut_factors(1)) ! in Potentials.f90
-                else
-                   cut_factors(1) = 1.d0
-                end if
+    ! loop over neighbors
+    do j = 1, neighbors_within(nbors1,atom1%max_bond_radius)
+       
+       ! neighboring atom
+       index2 = nbors1%neighbors(j)          
+       atom2 = atoms(index2)
+       atom_list(1) = atom1
+       atom_list(2) = atom2
 
-                ! If there is a bond order factor associated with the potential,
-                ! we add the contribution is brings:
-                if(interaction%pot_index > -1)then
-                   ! get b_i (for all i, they have been precalculated)
-                   call core_get_bond_order_factors(interaction%pot_index,&
-                        bo_factors)
+       ! calculate atom1-atom2 separation vector
+       ! and distance
+       call separation_vector(atom1%position, &
+            atom2%position, &
+            nbors1%pbc_offsets(1:3,j), &
+            core_cell_of_atom(atom1%index), &
+            separations(1:3,1)) ! in Geometry.f90
+       distances(1) = .norm.(separations(1:3,1))
+       if(distances(1) == 0.d0)then
+          directions(1:3,1) = (/ 0.d0, 0.d0, 0.d0 /)
+       else
+          directions(1:3,1) = separations(1:3,1) / distances(1)
+       end if
+          
+       many_bodies_found = .false.
 
-                   ! get B_ij and \nabla_a B_ij for this ij (not precalculated)
-                   ! this is 
-                   ! B_ij = (B*_ij + B*_ji) / 2
-                   call core_calculate_pair_bond_order_factor(index_pair, &
-                        separations(1:3,1), distances(1), directions(1:3,1), &
-                        interaction%pot_index, &
-                        pair_bo_sums(1:2))
-                   call core_post_process_pair_bond_order_factor(atom1, &
-                        interaction%pot_index, &
-                        pair_bo_sums(1), &
-                        pair_bo_factors(1))
-                   call core_post_process_pair_bond_order_factor(atom2, &
-                        interaction%pot_index, &
-                        pair_bo_sums(2), &
-                        pair_bo_factors(2))
+       !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
+       ! apply 2-body bond order factors !
+       !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
 
-                else
+       if(distances(1) < atom1%max_bond_radius)then
 
-                end if
+          ! loop over bond order factors affecting atom1
+          do k1 = 1, size(bond_indices)
+          
+             bond_params(1) = bond_factors(bond_indices(k1))
 
-                ! evaluate the 2-body e-neg involving atom1-atom2 interaction
-                call evaluate_electronegativity(2,interaction%n_product,separations(1:3,1),distances(1),&
-                     interaction,tmp_enegs(1:2),atom_doublet) ! in Potentials.f90
+             ! filter the bond indices before applying by checking:
+             ! number of targets,
+             ! is atom2 affected by the factor,
+             ! is the factor in the correct group
+             call bond_order_factor_is_in_group(bond_params(1),group_index,is_in_group) ! in Potentials.f90
+             if( is_in_group .and. bond_params(1)%cutoff > distances(1) )then
+                call bond_order_factor_affects_atom(bond_params(1),atom2,is_active,2) ! in Potentials.f90
+                if( is_active )then
+                   call get_number_of_targets_of_bond_order_factor_index(bond_params(1)%type_index,&
+                        n_targets) ! in Potentials.f90
+                   if( n_targets == 2 )then
+                      
+                      ! evaluate the atom1-atom2 term in the bond gradient sum
+                      call evaluate_bond_order_gradient(2,&
+                           separations(1:3,1),&
+                           distances(1),&
+                           bond_params(1),&
+                           tmp_grad(1:3,1:2,1:2),&
+                           atom_list(1:2)) ! in Potentials.f90
 
 
-                if(interaction%pot_index > -1)then
-                    ! e-neg on atom 1:
-                    enegs(index1) = enegs(index1) + &
-                     ( tmp_enegs(1) * cut_factors(1) ) * &
-                     ( bo_factors(index1) +  bo_factors(index2) + &
-                     pair_bo_factors(1) + pair_bo_factors(2) ) * 0.5d0
+                      if( post_process1 > 0)then
+                         call post_process_bond_order_gradient(bo_sums(index1),&
+                              tmp_grad(1:3,1,1),&
+                              bond_factors( post_process1 ),&
+                              new_grad(1:3,1))
+                         call post_process_bond_order_gradient(bo_sums(index1),&
+                              tmp_grad(1:3,1,2),&
+                              bond_factors( post_process1 ),&
+                              new_grad(1:3,2))
+                         new_grad(1:3,1) = - prefactor*new_grad(1:3,1)
+                         new_grad(1:3,2) = - prefactor*new_grad(1:3,2)
+                      else
+                         new_grad(1:3,1) = - prefactor*tmp_grad(1:3,1,1)
+                         new_grad(1:3,2) = - prefactor*tmp_grad(1:3,1,2)
+                      end if
+                      
+                      forces(1:3,index1) = forces(1:3,index1) + new_grad(1:3,1)
+                      forces(1:3,index2) = forces(1:3,index2) + new_grad(1:3,2)
 
-                    ! e-neg on atom 2:
-                    enegs(index2) = enegs(index2) + &
-                     ( tmp_enegs(2) * cut_factors(1) ) * &
-                     ( bo_factors(index1) +  bo_factors(index2) + &
-                     pair_bo_factors(1) + pair_bo_factors(2)  ) * 0.5d0
-                else
-                    ! e-neg on atom 1:
-                    enegs(index1) = enegs(index1) + &
-                     ( tmp_enegs(1) * cut_factors(1) ) 
+                      !temp_gradient(1:3,index1,1) = temp_gradient(1:3,index1,1) + tmp_grad(1:3,1,1)
+                      !temp_gradient(1:3,index2,1) = temp_gradient(1:3,index2,1) + tmp_grad(1:3,1,2)
+                      
+                      ! virial: r_a*f_b (xx, yy, zz, yz, xz, xy)
+                      virial(1) = virial(1) + separations(1,1) * tmp_grad(1,1,2)
+                      virial(2) = virial(2) + separations(2,1) * tmp_grad(2,1,2)
+                      virial(3) = virial(3) + separations(3,1) * tmp_grad(3,1,2)
+                      virial(4) = virial(4) + separations(2,1) * tmp_grad(3,1,2)
+                      virial(5) = virial(5) + separations(1,1) * tmp_grad(3,1,2)
+                      virial(6) = virial(6) + separations(1,1) * tmp_grad(2,1,2)
+                      
+                   else if( n_targets > 2 )then
+                      
+                      ! If the number of targets is greater than 2,
+                      ! we have found a many-body bond order factor.
+                      ! Make a note that we must also evaluate the many-body factors.
 
-                    ! e-neg on atom 2:
-                    enegs(index2) = enegs(index2) + &
-                     ( tmp_enegs(2) * cut_factors(1) ) 
-                
-                end if
+                      ! many bodies are only relevant for per-atom factors here
+                      call get_level_of_bond_order_factor_index(bond_params(1)%type_index, n_level)
+                      if(n_level == 1)then
+                         many_bodies_found = .true.
+                      end if
 
-          else if(n_targets > 2)then
+                   end if ! n_targets == 2
+                end if ! is_active
+             end if ! is_in_group
+             
+          end do ! k1 = 1, size(bond_indices)
+       end if ! distance < max_cut
+    end do ! j
 
-             ! If the number of targets is greater than 2,
-             ! we have found a many-body potential.
-             ! Make a note that we must also evaluate the many-body terms.
-             many_bodies_found = .true.
-             n_manybody = n_manybody + 1
-             manybody_indices(n_manybody) = interaction_indices(k)
+    if( many_bodies_found )then
+          write(*,*) " **** The many-body per-atom bond order factors are currently turned off, **** "
+          write(*,*) " **** since only the slow debug version has been implemented.             **** "
+          call exit(1)
+    end if
 
-          end if ! n_targets == 2
+    ! Post process the virial in two batches
+    ! The scaling function is the same as for the
+    ! gradient itself
+    if( post_process1 > 0 )then
+       call post_process_bond_order_gradient(bo_sums(index1),&
+            virial(1:3),&
+            bond_factors( post_process1 ),&
+            total_virial(1:3))
+       call post_process_bond_order_gradient(bo_sums(index1),&
+            virial(4:6),&
+            bond_factors( post_process1 ),&
+            total_virial(4:6))
+    else
+       total_virial = virial
+    end if
 
-       end if ! is_active
-       end if ! cutoff
-    end do ! k
+    ! Add the contribution of bond order gradients to the stress tensor
+    stress(1:6) = stress(1:6) - prefactor * total_virial(1:6)
 
-  end subroutine core_evaluate_local_doublet_electronegativities_B
+  end subroutine core_add_bond_order_forces
 
 
 
 
-  ! Evaluates the local electronegativity affecting two atoms.
+  ! Evaluates the local force affecting two atoms from bond order factors.
   !
+  ! *n_atoms total number of atoms in the system
   ! *index1 index of the atom 1
   ! *index2 index of the atom 2
   ! *atom_doublet the atoms that are targeted
   ! *test_index1 if 1, test if the ineraction targets atom1; similarly for 2
-  ! *interaction_indices the interactions targeting the given atoms
+  ! *interaction the interactions targeting the given atoms
   ! *separations distance vector from 1 to 2, as an array
   ! *directions unit vector from 1 to 2, as an array
   ! *distances distance from 1 to 2, as an array
-  ! *enegs calculated electronegativities
+  ! *forces calculated forces
+  ! *stress calculated stress
   ! *many_bodies_found returns true if the loop finds an interaction with 3 or more targets
-  subroutine core_evaluate_local_doublet_electronegativities(n_atoms, &
-       atom_doublet, &
+  subroutine core_add_pair_bond_order_forces(  &
+       !atom_doublet, &
        index1, index2, &
-       test_index1, &
-       interaction_indices, &
-       separations, directions, distances, &
-       enegs, &
-       many_bodies_found)
+       interaction, prefactor, &
+       separation, direction, distance, &
+       group_index, pair_bo_sums, pair_bo_factors, &
+       forces, stress )
     implicit none
-    integer, intent(in) :: n_atoms, index1, index2, test_index1
-    integer, pointer :: interaction_indices(:)
-    double precision, intent(inout) :: enegs(n_atoms)
-    type(atom), intent(in) :: atom_doublet(2)
-    double precision, intent(in) :: separations(3,1), directions(3,1), distances(1)
-    logical, intent(out) :: many_bodies_found
+    integer, intent(in) :: index1, index2, group_index
+    double precision, intent(inout) :: forces(:,:), stress(6)
+    !type(atom), intent(in) :: atom_doublet(2)
+    double precision, intent(in) :: separation(3), direction(3), distance, &
+         prefactor, pair_bo_factors(2), pair_bo_sums(2)
     
-    type(atom) :: atom1, atom2
-    integer :: k, n_targets, index_pair(2)
+    integer :: i,j,k,k1,l, index3, n_targets, index_pair(2), n_atoms, offset(3), &
+         post_process1, post_process2, indexA
     type(potential) :: interaction
-    double precision :: bo_factors(n_atoms), bo_sums(n_atoms), bo_gradients(3,n_atoms,3), &
-         tmp_energy, tmp_forces(3,2), tmp_enegs(2), &
-         cut_factors(1), &
-         pair_forces(3,2), bo_virial(6,2), &
-         pair_bo_sums(2), pair_bo_factors(2)
-    logical :: is_active
-
-    many_bodies_found = .false.
-    atom1 = atom_doublet(1)
-    atom2 = atom_doublet(2)
-    index_pair = (/ index1, index2 /)
+    type(bond_order_parameters) :: bond_params
+    double precision :: &
+         separations(3,2), directions(3,2), distances(2), &
+         tmp_energy, tmp_grad(3,3), new_grad(3,3), tmp_forces(3,2), &
+         virial(6,2), total_virial(6,2), dummy_grad(3,2), process_factor(2)
 
-    ! loop over potentials affecting atom1
-    do k = 1, size(interaction_indices)
+    logical :: is_active, is_in_group
+    integer, pointer :: bond_indices(:), bond_indices2(:)
 
-       interaction = interactions(interaction_indices(k))
+    type(atom) :: atom1, atom2, atom3
+    type(atom) :: atom_list(3)
+    type(neighbor_list) :: nbors1, nbors2
 
-       ! filter the potentials by:
-       ! is atom2 affected by the potential,
-       ! is it a 2-body potential
-       if( interaction%cutoff > distances(1) )then 
-       call potential_affects_atom(interaction,atom_doublet(test_index1),is_active,2) ! in Potentials.f90
-       if( is_active )then 
-          call get_number_of_targets_of_potential_index(interaction%type_index,&
-               n_targets) ! in Potentials.f90
-          if( n_targets == 2 )then
 
+    n_atoms = size(atoms)
+    !atom1 = atom_doublet(1)
+    !atom2 = atom_doublet(2)
+    index_pair = (/ index1, index2 /)
 
-                !****************************************!
-                ! 2-body electronegativity (atom1-atom2) !
-                !****************************************!
+    ! target atom 1
+    atom1 = atoms(index1)
+    nbors1 = atom1%neighbor_list
+    bond_indices => atom1%bond_indices
 
-                ! If a smooth cutoff is present, we add the
-                ! contribution it brings:
-                if(interaction%smoothened)then
-                   ! get f(r_ij)
-                   call smoothening_factor(distances(1),&
-                        interaction%cutoff,interaction%soft_cutoff,&
-                        cut_factors(1)) ! in Potentials.f90
-                else
-                   cut_factors(1) = 1.d0
-                end if
+    ! target atom 2
+    atom2 = atoms(index2)
+    nbors2 = atom2%neighbor_list
+    bond_indices2 => atom2%bond_indices
+    virial = 0.d0
 
-                ! If there is a bond order factor associated with the potential,
-                ! we add the contribution is brings:
-                if(interaction%pot_index > -1)then
-                   ! get b_i (for all i, they have been precalculated)
-                   call core_get_bond_order_factors(interaction%pot_index,&
-                        bo_factors)
 
-                   ! get B_ij and \nabla_a B_ij for this ij (not precalculated)
-                   ! this is 
-                   ! B_ij = (B*_ij + B*_ji) / 2
-                   call core_calculate_pair_bond_order_factor(index_pair, &
-                        separations(1:3,1), distances(1), directions(1:3,1), &
-                        interaction%pot_index, &
-                        pair_bo_sums(1:2))
-                   call core_post_process_pair_bond_order_factor(atom1, &
-                        interaction%pot_index, &
-                        pair_bo_sums(1), &
-                        pair_bo_factors(1))
-                   call core_post_process_pair_bond_order_factor(atom2, &
-                        interaction%pot_index, &
-                        pair_bo_sums(2), &
-                        pair_bo_factors(2))
+    ! Check all the bond factors that affect the atoms and see
+    ! if any of them require post processing.
+    ! If such a factor is found, the corresponding parameters
+    ! are saved to be used for the post processing.
+    ! Note that only one set of post processing parameters will
+    ! be used: the first found. This is because there may well
+    ! be several factors acting on the same type of atom and
+    ! we do not want to apply the post processing several times.
+    post_process1 = -1
+    do indexA = 1, size(bond_indices)
+       bond_params = bond_factors(bond_indices(indexA))
+       call bond_order_factor_is_in_group(bond_params,group_index,is_in_group) ! in Potentials.f90
+       if(is_in_group)then
+          if( bond_params%includes_post_processing .and. bond_params%n_level == 2 )then
+             if( bond_params%original_elements(1) == atom1%element )then
+                ! store the index of the parameters 
+                post_process1 = bond_indices(indexA)
+                dummy_grad = 1.d0
+                call post_process_bond_order_gradient(pair_bo_sums(1), &
+                     dummy_grad(1:3,1), &
+                     bond_params, &
+                     dummy_grad(1:3,2) ) ! in Potentials.f90
+                process_factor(1) = dummy_grad(1,2)
+                exit
+             end if
+          end if
+       end if
+    end do
 
-                else
-                   !bo_factors = 1.d0
-                end if
+    post_process2 = -1
+    do indexA = 1, size(bond_indices2)
+       bond_params = bond_factors(bond_indices2(indexA))
+       call bond_order_factor_is_in_group(bond_params,group_index,is_in_group) ! in Potentials.f90
+       if(is_in_group)then
+          if( bond_params%includes_post_processing .and. bond_params%n_level == 2 )then
+             if( bond_params%original_elements(1) == atom2%element )then
+                ! store the index of the parameters 
+                post_process2 = bond_indices2(indexA)
+                dummy_grad = 1.d0
+                call post_process_bond_order_gradient(pair_bo_sums(2), &
+                     dummy_grad(1:3,1), &
+                     bond_params, &
+                     dummy_grad(1:3,2) ) ! in Potentials.f90
+                process_factor(2) = dummy_grad(1,2)
+                exit
+             end if
+          end if
+       end if
+    end do
 
-                ! evaluate the 2-body e-neg involving atom1-atom2 interaction
-                call evaluate_electronegativity(2,interaction%n_product,separations(1:3,1),distances(1),&
-                     interaction,tmp_enegs(1:2),atom_doublet) ! in Potentials.f90
+    ! In the 3-body loop, we search the neighbors of both atom1
+    ! and atom2 to find the triplets 
+    ! atom1-atom2-atom3 and
+    ! atom2-atom1-atom3
+    ! These are considered to be different, since the middle atom of
+    ! the triplet is different (atom2 vs. atom1).
+    
+    ! First we try to find ordered triplets atom2 -- atom1 -- atom3
+    ! Therefore we need separations a2--a1 and a1--a3.
 
+    ! atom2 - atom1 vector
+    separations(1:3,1) = -separation(1:3)
+    distances(1) = distance
+    directions(1:3,1) = -direction(1:3)
+        
 
-                if(interaction%pot_index > -1)then
-                    ! e-neg on atom 1:
-                    enegs(index1) = enegs(index1) + &
-                     ( tmp_enegs(1) * cut_factors(1) ) * &
-                     ( bo_factors(index1) +  bo_factors(index2) + &
-                     pair_bo_factors(1) + pair_bo_factors(2) ) * 0.5d0
+    ! loop over neighbors of atom 1
+    do j = 1, neighbors_within(nbors1,atom1%max_bond_radius)
+       
+       ! neighboring atom
+       index3 = nbors1%neighbors(j)
+       offset(1:3) = nbors1%pbc_offsets(1:3,j)
+       
+       atom3 = atoms(index3)
+       atom_list = (/ atom2, atom1, atom3 /)
+       
+       ! calculate atom1-atom3 separation vector
+       ! and distance
+       call separation_vector(atom1%position, &
+            atom3%position, &
+            offset(1:3), &
+            core_cell_of_atom(atom1%index), &
+            separations(1:3,2)) ! in Geometry.f90
+       distances(2) = .norm.(separations(1:3,2))
+       if(distances(2) == 0.d0)then
+          directions(1:3,2) = (/ 0.d0, 0.d0, 0.d0 /)
+       else
+          directions(1:3,2) = separations(1:3,2) / distances(2)
+       end if
+       
+       ! To prevent the case index2 - index1 - index2
+       if(any(separations(1:3,1)+separations(1:3,2) /= 0.d0))then
+   
+          !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
+          ! apply 3-body bond order factors !
+          !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
 
-                    ! e-neg on atom 2:
-                    enegs(index2) = enegs(index2) + &
-                     ( tmp_enegs(2) * cut_factors(1) ) * &
-                     ( bo_factors(index1) +  bo_factors(index2) + &
-                     pair_bo_factors(1) + pair_bo_factors(2)  ) * 0.5d0
-                else
-                    ! e-neg on atom 1:
-                    enegs(index1) = enegs(index1) + &
-                     ( tmp_enegs(1) * cut_factors(1) ) 
+          if(distances(2) < atom1%max_bond_radius)then
 
-                    ! e-neg on atom 2:
-                    enegs(index2) = enegs(index2) + &
-                     ( tmp_enegs(2) * cut_factors(1) ) 
+             ! search for the first bond params containing the parameters for (atom2-atom1) -- atom3
+             do k1 = 1, size(bond_indices)
                 
-                end if
-
-          else if(n_targets > 2)then
-
-             ! If the number of targets is greater than 2,
-             ! we have found a many-body potential.
-             ! Make a note that we must also evaluate the many-body terms.
-             many_bodies_found = .true.
-
-          end if ! n_targets == 2
-
-       end if ! is_active
-       end if ! cutoff
-    end do ! k
-
-  end subroutine core_evaluate_local_doublet_electronegativities
-
-
+                bond_params = bond_factors(bond_indices(k1))
+                
+                ! filter the parameters by:
+                ! number of targets, atom2 and atom3 being targets, group index                   
+                call bond_order_factor_is_in_group(bond_params,&
+                     group_index,is_in_group) ! in Potentials.f90
+                            
+                if( is_in_group )then
+                   call bond_order_factor_affects_atom(bond_params,&
+                        atom2,is_active,2) ! in Potentials.f90
+                   if( is_active )then
+                      call get_number_of_targets_of_bond_order_factor_index(bond_params%type_index,&
+                           n_targets) ! in Potentials.f90
+                      if( n_targets == 3 )then
+                         call bond_order_factor_affects_atom(bond_params,&
+                              atom3,is_active,3) ! in Potentials.f90
+                         if( is_active )then
+                            
+                            
+                            ! Evaluate the atom2-atom1-atom3 triplet contribution
+                            ! in the bond gradient sum.
+                            ! The gradient is stored in tmp_grad whose indices are
+                            ! (xyz, factor index, moved atom index)
+                            call evaluate_pair_bond_order_gradient(3,&
+                                 separations(1:3,1:2),&
+                                 distances(1:2),&
+                                 bond_params,&
+                                 tmp_grad(1:3,1:3),&
+                                 atom_list) ! in Potentials.f90
+                            
+               
+                            if( post_process1 > 0)then
+!!$                               call post_process_bond_order_gradient(pair_bo_sums(1),&
+!!$                                    tmp_grad(1:3,1),&
+!!$                                    bond_factors( post_process1 ),&
+!!$                                    new_grad(1:3,1))
+!!$                               call post_process_bond_order_gradient(pair_bo_sums(1),&
+!!$                                    tmp_grad(1:3,2),&
+!!$                                    bond_factors( post_process1 ),&
+!!$                                    new_grad(1:3,2))
+!!$                               call post_process_bond_order_gradient(pair_bo_sums(1),&
+!!$                                    tmp_grad(1:3,3),&
+!!$                                    bond_factors( post_process1 ),&
+!!$                                    new_grad(1:3,3))
+                               new_grad(1:3,1:3) = - process_factor(1)*prefactor*tmp_grad(1:3,1:3)
+                            else
+                               new_grad(1:3,1:3) = - prefactor*tmp_grad(1:3,1:3)
+                            end if
+ 
+                            ! store the gradients of the pair bond factor
+                            ! with respect to moving atom1, atom2, atom3
+                            ! The triplet is atom2-atom1-atom3, so index2 gets the first
+                            ! entry in the second column of tmp_grad.
+                            forces(1:3,index2) = forces(1:3,index2) + new_grad(1:3,1)
+                            forces(1:3,index1) = forces(1:3,index1) + new_grad(1:3,2)
+                            forces(1:3,index3) = forces(1:3,index3) + new_grad(1:3,3)
 
+                            ! virial: r_a*f_b (xx, yy, zz, yz, xz, xy) 
+                            ! r from atom1 to other atoms - now atom1 is center atom
+                            virial(1,1) = virial(1,1) - separations(1,1) * tmp_grad(1,1) & ! r_12*f2
+                                 + separations(1,2) * tmp_grad(1,3)   ! r_13*f3
+                            virial(2,1) = virial(2,1) - separations(2,1) * tmp_grad(2,1) & ! r_12*f2
+                                 + separations(2,2) * tmp_grad(2,3)   ! r_13*f3
+                            virial(3,1) = virial(3,1) - separations(3,1) * tmp_grad(3,1) & ! r_12*f2
+                                 + separations(3,2) * tmp_grad(3,3)   ! r_13*f3
+                            virial(4,1) = virial(4,1) - separations(2,1) * tmp_grad(3,1) & ! r_12*f2
+                                 + separations(2,2) * tmp_grad(3,3)   ! r_13*f3
+                            virial(5,1) = virial(5,1) - separations(1,1) * tmp_grad(3,1) & ! r_12*f2
+                                 + separations(1,2) * tmp_grad(3,3)   ! r_13*f3
+                            virial(6,1) = virial(6,1) - separations(1,1) * tmp_grad(2,1) & ! r_12*f2
+                                 + separations(1,2) * tmp_grad(2,3)   ! r_13*f3
+                            
+                         end if ! is_active
+                      end if ! n_targets == 3
+                   end if ! is_active
+                end if ! is_in_group
+             end do ! k1
+          end if ! distance < max_cut
+       end if ! index3 /= index2
 
-  ! Evaluates the interactions affecting two atoms.
-  !
-  ! *n_atoms total number of atoms in the system
-  ! *index1 index of the atom 1
-  ! *index2 index of the atom 2
-  ! *atom_doublet the atoms that are targeted
-  ! *test_index1 if 1, test if the ineraction targets atom1; similarly for 2
-  ! *interaction_indices the interactions targeting the given atoms
-  ! *separations distance vector from 1 to 2, as an array
-  ! *directions unit vector from 1 to 2, as an array
-  ! *distances distance from 1 to 2, as an array
-  ! *calculation_type the type of information requested
-  ! *energy calculated energy
-  ! *forces calculated forces
-  ! *stress calculated stress
-  ! *enegs calculated electronegativities
-  ! *many_bodies_found returns true if the loop finds an interaction with 3 or more targets
-  subroutine core_evaluate_local_doublet(n_atoms, &
-       atom_doublet, &
-       index1, index2, &
-       test_index1, &
-       interaction_indices, &
-       separations, directions, distances, &
-       calculation_type,energy,forces,enegs,stress, &
-       many_bodies_found)
-    implicit none
-    integer, intent(in) :: calculation_type, n_atoms, index1, index2, test_index1
-    integer, pointer :: interaction_indices(:)
-    double precision, intent(inout) :: energy, forces(3,n_atoms), enegs(n_atoms), stress(6)
-    type(atom), intent(in) :: atom_doublet(2)
-    double precision, intent(in) :: separations(3,1), directions(3,1), distances(1)
-    logical, intent(out) :: many_bodies_found
-    
-    type(atom) :: atom1, atom2
-    integer :: k, n_targets, index_pair(2)
-    type(potential) :: interaction
-    double precision :: bo_factors(n_atoms), bo_sums(n_atoms), bo_gradients(3,n_atoms,3), &
-         tmp_energy, tmp_forces(3,2), tmp_enegs(2), &
-         cut_factors(1), cut_gradients(3,1), &
-         pair_forces(3,2), bo_virial(6,2), &
-         pair_bo_sums(2), pair_bo_factors(2), &
-         pair_bo_gradients(3,n_atoms,2), pair_bo_virial(6,2)
-    logical :: is_active
+    end do ! j = 1, nbors1%n_neighbors
 
-    many_bodies_found = .false.
-    atom1 = atom_doublet(1)
-    atom2 = atom_doublet(2)
-    index_pair = (/ index1, index2 /)
 
-    ! loop over potentials affecting atom1
-    do k = 1, size(interaction_indices)
+    ! Next we try to find ordered triplets atom1 -- atom2 -- atom3
+    ! Therefore we need separations a1--a2 and a2--a3.
+    separations(1:3,1) = -separations(1:3,1)
+    directions(1:3,1) = -directions(1:3,1)
 
-       interaction = interactions(interaction_indices(k))
+    ! loop over neighbors of atom 2
+    do j = 1, neighbors_within(nbors2,atom2%max_bond_radius)
+       
+       ! neighboring atom
+       index3 = nbors2%neighbors(j)
+       offset(1:3) = nbors2%pbc_offsets(1:3,j)
 
-       ! filter the potentials by:
-       ! is atom2 affected by the potential,
-       ! is it a 2-body potential
-       if( interaction%cutoff > distances(1) )then 
-       call potential_affects_atom(interaction,atom_doublet(test_index1),is_active,2) ! in Potentials.f90
-       if( is_active )then 
-          call get_number_of_targets_of_potential_index(interaction%type_index,&
-               n_targets) ! in Potentials.f90
-          if( n_targets == 2 )then
+       atom3 = atoms(index3)
+       atom_list = (/ atom1, atom2, atom3 /)
+       
+       ! calculate atom2-atom3 separation vector
+       ! and distance
+       call separation_vector(atom2%position, &
+            atom3%position, &
+            offset(1:3), &
+            core_cell_of_atom(atom2%index), &
+            separations(1:3,2)) ! in Geometry.f90
+       distances(2) = .norm.(separations(1:3,2))
+       if(distances(2) == 0.d0)then
+          directions(1:3,2) = (/ 0.d0, 0.d0, 0.d0 /)
+       else
+          directions(1:3,2) = separations(1:3,2) / distances(2)
+       end if
+       
+       ! To prevent the case index2 - index1 - index2
+       if(any(separations(1:3,1)+separations(1:3,2) /= 0.d0))then
 
-             ! differentiate between energy, force, and electronegativity evaluation
-             select case(calculation_type)
-             case(energy_evaluation_index)
+          !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
+          ! apply 3-body bond order factors !
+          !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
 
-                !*****************************!
-                ! 2-body energy (atom1-atom2) !
-                !*****************************!
+          if(distances(2) < atom2%max_bond_radius)then
 
-                ! If there is a bond order factor associated with the potential,
-                ! we add the contribution is brings:
-                !
-                ! V = \sum_ij b_ij v_ij
-                ! b_ij = (b_i + b_j) / 2 + B_ij
-                if(interaction%pot_index > -1)then
-                   ! get b_i (for all i, they have been precalculated)
-                   call core_get_bond_order_factors(interaction%pot_index,&
-                        bo_factors)
+             ! search for the bond params containing the parameters for (atom1-atom2) -- atom3
+             do k1 = 1, size(bond_indices2)
+                
+                bond_params = bond_factors(bond_indices2(k1))
+                
+                ! filter the parameters by:
+                ! number of targets, atom2 and atom3 being targets, group index                   
+                call bond_order_factor_is_in_group(bond_params,&
+                     group_index,is_in_group) ! in Potentials.f90
+                
+                if( is_in_group )then
+                   call bond_order_factor_affects_atom(bond_params,&
+                        atom1,is_active,2) ! in Potentials.f90
+                   if( is_active )then
+                      call get_number_of_targets_of_bond_order_factor_index(bond_params%type_index,&
+                           n_targets) ! in Potentials.f90
+                      if( n_targets == 3 )then
+                         call bond_order_factor_affects_atom(bond_params,&
+                              atom3,is_active,3) ! in Potentials.f90
+                         if( is_active )then            
+                            
+                            ! Evaluate the atom2-atom1-atom3 triplet contribution
+                            ! in the bond gradient sum.
+                            ! The gradient is stored in tmp_grad whose indices are
+                            ! (xyz, factor index, moved atom index)
+                            call evaluate_pair_bond_order_gradient(3,&
+                                 separations(1:3,1:2),&
+                                 distances(1:2),&
+                                 bond_params,&
+                                 tmp_grad(1:3,1:3),&
+                                 atom_list) ! in Potentials.f90
+                                                        
+                            if( post_process2 > 0)then                               
+!!$                               call post_process_bond_order_gradient(pair_bo_sums(2),&
+!!$                                    tmp_grad(1:3,1),&
+!!$                                    bond_factors( post_process2 ),&
+!!$                                    new_grad(1:3,1))
+!!$                               call post_process_bond_order_gradient(pair_bo_sums(2),&
+!!$                                    tmp_grad(1:3,2),&
+!!$                                    bond_factors( post_process2 ),&
+!!$                                    new_grad(1:3,2))
+!!$                               call post_process_bond_order_gradient(pair_bo_sums(2),&
+!!$                                    tmp_grad(1:3,3),&
+!!$                                    bond_factors( post_process2 ),&
+!!$                                    new_grad(1:3,3))
+!!$                               new_grad(1:3,1) = - prefactor*new_grad(1:3,1)
+!!$                               new_grad(1:3,2) = - prefactor*new_grad(1:3,2)
+!!$                               new_grad(1:3,3) = - prefactor*new_grad(1:3,3)
+                               new_grad(1:3,1:3) = - process_factor(2)*prefactor*tmp_grad(1:3,1:3)
+                            else
+                               new_grad(1:3,1) = - prefactor*tmp_grad(1:3,1)
+                               new_grad(1:3,2) = - prefactor*tmp_grad(1:3,2)
+                               new_grad(1:3,3) = - prefactor*tmp_grad(1:3,3)
+                            end if
 
-                   ! get B_ij for this ij (not precalculated)
-                   ! this is 
-                   ! B_ij = (B*_ij + B*_ji) / 2
-                   call core_calculate_pair_bond_order_factor(index_pair, &
-                        separations(1:3,1), distances(1), directions(1:3,1), &
-                        interaction%pot_index, &
-                        pair_bo_sums(1:2))
-                   call core_post_process_pair_bond_order_factor(atom1, &
-                        interaction%pot_index, &
-                        pair_bo_sums(1), &
-                        pair_bo_factors(1))
-                   call core_post_process_pair_bond_order_factor(atom2, &
-                        interaction%pot_index, &
-                        pair_bo_sums(2), &
-                        pair_bo_factors(2))
 
-                else
-                   !bo_factors = 1.d0
-                end if
+                            ! store the gradients of the pair bond factor
+                            ! with respect to moving atom1, atom2, atom3
+                            ! The triplet is atom1-atom2-atom3, so index1 gets the first
+                            ! entry in the second column of tmp_grad.                            
+                            forces(1:3,index1) = forces(1:3,index1) + new_grad(1:3,1)
+                            forces(1:3,index2) = forces(1:3,index2) + new_grad(1:3,2)
+                            forces(1:3,index3) = forces(1:3,index3) + new_grad(1:3,3)
 
-                ! If a smooth cutoff is present, we add the
-                ! contribution it brings:
-                ! 
-                ! V = \sum_ij v_ij f(r_ij)
-                if(interaction%smoothened)then
-                   ! get f(r_ij)
-                   call smoothening_factor(distances(1),&
-                        interaction%cutoff,interaction%soft_cutoff,&
-                        cut_factors(1)) ! in Potentials.f90
-                else
-                   cut_factors(1) = 1.d0
-                end if
+                            ! virial: r_a*f_b (xx, yy, zz, yz, xz, xy) 
+                            ! r from atom1 to other atoms - now atom1 is center atom
+                            virial(1,2) = virial(1,2) - separations(1,1) * tmp_grad(1,1) & ! r_12*f2
+                                 + separations(1,2) * tmp_grad(1,3)   ! r_13*f3
+                            virial(2,2) = virial(2,2) - separations(2,1) * tmp_grad(2,1) & ! r_12*f2
+                                 + separations(2,2) * tmp_grad(2,3)   ! r_13*f3
+                            virial(3,2) = virial(3,2) - separations(3,1) * tmp_grad(3,1) & ! r_12*f2
+                                 + separations(3,2) * tmp_grad(3,3)   ! r_13*f3
+                            virial(4,2) = virial(4,2) - separations(2,1) * tmp_grad(3,1) & ! r_12*f2
+                                 + separations(2,2) * tmp_grad(3,3)   ! r_13*f3
+                            virial(5,2) = virial(5,2) - separations(1,1) * tmp_grad(3,1) & ! r_12*f2
+                                 + separations(1,2) * tmp_grad(3,3)   ! r_13*f3
+                            virial(6,2) = virial(6,2) - separations(1,1) * tmp_grad(2,1) & ! r_12*f2
+                                 + separations(1,2) * tmp_grad(2,3)   ! r_13*f3
+                            
+                         end if ! is_active
+                      end if ! n_targets == 3
+                   end if ! is_active
+                end if ! is_in_group
+             end do ! k1
+          end if ! distance < max_cut
+       end if ! index3 /= index1
 
-                ! evaluate the 2-body energy involving atom1-atom2 interaction
-                call evaluate_energy(2,interaction%n_product,separations(1:3,1),distances(1),&
-                     interaction,tmp_energy,atom_doublet)  ! in Potentials.f90
+    end do ! j = 1, nbors2%n_neighbors
 
-                ! add the term: b_ij v_ij f(rij)
-                if(interaction%pot_index > -1)then
-                    energy = energy + tmp_energy*cut_factors(1)*&
-                         (bo_factors(index1)+bo_factors(index2)+pair_bo_factors(1)+pair_bo_factors(2))*0.5d0
-                else
-                    energy = energy + tmp_energy*cut_factors(1)
-                end if
 
-             case(force_evaluation_index)
+    ! Post process the virial in two batches
+    ! The scaling function is the same as for the
+    ! gradient itself
+    if( post_process1 > 0 )then
 
-                !****************************!
-                ! 2-body force (atom1-atom2) !
-                !****************************!
+       call post_process_bond_order_gradient(pair_bo_sums(1), &
+            virial(1:3,1), &
+            bond_factors( post_process1 ), &
+            total_virial(1:3,1) ) ! in Potentials.f90
+       call post_process_bond_order_gradient(pair_bo_sums(1), &
+            virial(4:6,1), &
+            bond_factors( post_process1 ), &
+            total_virial(4:6,1) ) ! in Potentials.f90
 
-                ! We will need the energy contribution from atom1-atom2
-                ! interaction if smooth cutoffs or bond factors are used,
-                ! since we are mulplying the potential.
-                if((interaction%pot_index > -1) .or. &
-                     interaction%smoothened)then
-                   call evaluate_energy(2,interaction%n_product,separations(1:3,1),distances(1),&
-                        interaction,tmp_energy,atom_doublet) ! in Potentials.f90
-                else
-                   tmp_energy = 0.d0
-                end if
+    else
 
-                ! If a smooth cutoff is present, we add the
-                ! contribution it brings:
-                ! 
-                ! V = \sum_ij v_ij f(r_ij)
-                ! F_a = - \nabla_a V 
-                !     = - \sum_ij v_ij f'(r_ij) (\nabla_a r_ij) + (\nabla_a v_ij) f(r_ij) 
-                !     = - \sum_ij v_ij f'(r_ij) (\nabla_a r_ij) + f_a,ij f(r_ij)
-                !
-                if(interaction%smoothened)then
-                   ! get f(r_ij)
-                   call smoothening_factor(distances(1),&
-                        interaction%cutoff,interaction%soft_cutoff,&
-                        cut_factors(1)) ! in Potentials.f90
-                   ! get f'(r_ij) (\nabla_a r_ij)
-                   call smoothening_gradient(directions(1:3,1),distances(1),&
-                        interaction%cutoff,interaction%soft_cutoff,&
-                        cut_gradients(1:3,1)) ! in Potentials.f90
-                else
-                   cut_factors(1) = 1.d0
-                   cut_gradients(1:3,1) = 0.d0
-                end if
+       total_virial(1:6,1) = virial(1:6,1)
 
-                ! If there is a bond order factor associated with the potential,
-                ! we add the contribution is brings:
-                !
-                ! V = \sum_ij b_ij v_ij
-                ! b_ij = (b_i + b_j) / 2 + B_ij
-                ! F_a = - \nabla_a V 
-                !     = - \sum_ij (\nabla_a b_ij) v_ij + b_ij (\nabla_a v_ij)
-                !     = - \sum_ij (\nabla_a b_ij) v_ij + b_ij f_a,ij
-                !
-                if(interaction%pot_index > -1)then
-                   ! get b_i (for all i, they have been precalculated)
-                   call core_get_bond_order_factors(interaction%pot_index,&
-                        bo_factors)
-                   ! get (\nabla_a b_i) (for all a)
-                   call core_get_bond_order_gradients(interaction%pot_index,&
-                        index1,& ! atom index
-                        1, & ! slot_index
-                        bo_gradients(1:3,1:n_atoms,1), &
-                        bo_virial(1:6,1))
-                   ! get (\nabla_a b_j) (for all a)
-                   call core_get_bond_order_gradients(interaction%pot_index,&
-                        index2,& ! atom index
-                        2, & ! slot_index
-                        bo_gradients(1:3,1:n_atoms,2), &
-                        bo_virial(1:6,2))
+    end if
 
+    if( post_process2 > 0 )then
 
-                   ! get B_ij and \nabla_a B_ij for this ij (not precalculated)
-                   ! this is 
-                   ! B_ij = (B*_ij + B*_ji) / 2
-                   call core_calculate_pair_bond_order_factor(index_pair, &
-                        separations(1:3,1), distances(1), directions(1:3,1), &
-                        interaction%pot_index, &
-                        pair_bo_sums(1:2))
-                   call core_post_process_pair_bond_order_factor(atom1, &
-                        interaction%pot_index, &
-                        pair_bo_sums(1), &
-                        pair_bo_factors(1))
-                   call core_post_process_pair_bond_order_factor(atom2, &
-                        interaction%pot_index, &
-                        pair_bo_sums(2), &
-                        pair_bo_factors(2))
+       call post_process_bond_order_gradient(pair_bo_sums(2), &
+            virial(1:3,2), &
+            bond_factors( post_process2 ), &
+            total_virial(1:3,2) ) ! in Potentials.f90
+       call post_process_bond_order_gradient(pair_bo_sums(2), &
+            virial(4:6,2), &
+            bond_factors( post_process2 ), &
+            total_virial(4:6,2) ) ! in Potentials.f90
+    else
 
-                   call core_calculate_pair_bond_order_gradients(index_pair, &
-                        separations(1:3,1), distances(1), directions(1:3,1), &
-                        interaction%pot_index, &                        
-                        pair_bo_sums(1:2), &
-                        pair_bo_gradients(1:3,1:n_atoms,1:2), &
-                        pair_bo_virial(1:6,1:2))
+       total_virial(1:6,2) = virial(1:6,2)
 
+    end if
 
-                   ! Add the bond order gradient terms involving the 
-                   ! atom1-atom2 energy for all atoms.
-                   ! That is, add the (\nabla_a b_ij) v_ij term with 
-                   ! the given ij (atom1,atom2) for all a.
-                   forces(1:3,1:n_atoms) = forces(1:3,1:n_atoms) &
-                        - tmp_energy*cut_factors(1)*&
-                        (bo_gradients(1:3,1:n_atoms,1) + bo_gradients(1:3,1:n_atoms,2) + &
-                        pair_bo_gradients(1:3,1:n_atoms,1) + pair_bo_gradients(1:3,1:n_atoms,2))*0.5d0
+    ! Add the contribution of bond order gradients to the stress tensor
+    stress(1:6) = stress(1:6) - prefactor * ( total_virial(1:6,1) + total_virial(1:6,2) )
 
-                   ! Add the contribution of bond order gradients to the stress tensor
-                   stress(1:6) = stress(1:6) - tmp_energy*cut_factors(1)* &
-                        (bo_virial(1:6,1) + bo_virial(1:6,2) + pair_bo_virial(1:6,1) + pair_bo_virial(1:6,2))*0.5d0
 
-                else
-                   !bo_factors = 1.d0
-                   !bo_sums = 0.d0
-                   !bo_gradients = 0.d0
-                end if
+  end subroutine core_add_pair_bond_order_forces
 
-                ! evaluate the 2-body force involving atom1-atom2 interaction
-                call evaluate_forces(2,interaction%n_product,separations(1:3,1),distances(1),&
-                     interaction,tmp_forces(1:3,1:2),atom_doublet) ! in Potentials.f90
 
-                if(interaction%pot_index > -1)then
 
-                    ! force on atom 1:                 
-                    pair_forces(1:3,1) = ( tmp_forces(1:3,1) * cut_factors(1) + &
-                         tmp_energy * cut_gradients(1:3,1) ) * &
-                         ( bo_factors(index1) + bo_factors(index2) + &
-                         pair_bo_factors(1) + pair_bo_factors(2) ) * 0.5d0
-
-                    ! force on atom 2:
-                    pair_forces(1:3,2) = ( tmp_forces(1:3,2) * cut_factors(1) - &
-                         tmp_energy * cut_gradients(1:3,1) ) * &
-                         ( bo_factors(index1) + bo_factors(index2) + &
-                         pair_bo_factors(1) + pair_bo_factors(2) ) * 0.5d0
-                else
-                    pair_forces(1:3,1) = ( tmp_forces(1:3,1) * cut_factors(1) + &
-                         tmp_energy * cut_gradients(1:3,1) )
-                    pair_forces(1:3,2) = ( tmp_forces(1:3,2) * cut_factors(1) - &
-                         tmp_energy * cut_gradients(1:3,1) )
-                end if
-
-                forces(1:3,index1) = forces(1:3,index1) + pair_forces(1:3,1)
-                forces(1:3,index2) = forces(1:3,index2) + pair_forces(1:3,2)
-
-                !***************!
-                ! stress tensor !
-                !***************!
-                
-                ! s_xx, s_yy, s_zz, s_yz, s_xz, s_xy:
-                stress(1) = stress(1) + separations(1,1) * pair_forces(1,2)
-                stress(2) = stress(2) + separations(2,1) * pair_forces(2,2)
-                stress(3) = stress(3) + separations(3,1) * pair_forces(3,2)
-                stress(4) = stress(4) + separations(2,1) * pair_forces(3,2)
-                stress(5) = stress(5) + separations(1,1) * pair_forces(3,2)
-                stress(6) = stress(6) + separations(1,1) * pair_forces(2,2)
-
-             case(electronegativity_evaluation_index)
-
-                !****************************************!
-                ! 2-body electronegativity (atom1-atom2) !
-                !****************************************!
-
-                ! If a smooth cutoff is present, we add the
-                ! contribution it brings:
-                if(interaction%smoothened)then
-                   ! get f(r_ij)
-                   call smoothening_factor(distances(1),&
-                        interaction%cutoff,interaction%soft_cutoff,&
-                        cut_factors(1)) ! in Potentials.f90
-                else
-                   cut_factors(1) = 1.d0
-                end if
-
-                ! If there is a bond order factor associated with the potential,
-                ! we add the contribution is brings:
-                if(interaction%pot_index > -1)then
-                   ! get b_i (for all i, they have been precalculated)
-                   call core_get_bond_order_factors(interaction%pot_index,&
-                        bo_factors)
-
-                   ! get B_ij and \nabla_a B_ij for this ij (not precalculated)
-                   ! this is 
-                   ! B_ij = (B*_ij + B*_ji) / 2
-                   call core_calculate_pair_bond_order_factor(index_pair, &
-                        separations(1:3,1), distances(1), directions(1:3,1), &
-                        interaction%pot_index, &
-                        pair_bo_sums(1:2))
-                   call core_post_process_pair_bond_order_factor(atom1, &
-                        interaction%pot_index, &
-                        pair_bo_sums(1), &
-                        pair_bo_factors(1))
-                   call core_post_process_pair_bond_order_factor(atom2, &
-                        interaction%pot_index, &
-                        pair_bo_sums(2), &
-                        pair_bo_factors(2))
-
-                else
-                   !bo_factors = 1.d0
-                end if
-
-                ! evaluate the 2-body e-neg involving atom1-atom2 interaction
-                call evaluate_electronegativity(2,interaction%n_product,separations(1:3,1),distances(1),&
-                     interaction,tmp_enegs(1:2),atom_doublet) ! in Potentials.f90
-
-
-                if(interaction%pot_index > -1)then
-                    ! e-neg on atom 1:
-                    enegs(index1) = enegs(index1) + &
-                     ( tmp_enegs(1) * cut_factors(1) ) * &
-                     ( bo_factors(index1) +  bo_factors(index2) + &
-                     pair_bo_factors(1) + pair_bo_factors(2) ) * 0.5d0
-
-                    ! e-neg on atom 2:
-                    enegs(index2) = enegs(index2) + &
-                     ( tmp_enegs(2) * cut_factors(1) ) * &
-                     ( bo_factors(index1) +  bo_factors(index2) + &
-                     pair_bo_factors(1) + pair_bo_factors(2)  ) * 0.5d0
-                else
-                    ! e-neg on atom 1:
-                    enegs(index1) = enegs(index1) + &
-                     ( tmp_enegs(1) * cut_factors(1) ) 
-
-                    ! e-neg on atom 2:
-                    enegs(index2) = enegs(index2) + &
-                     ( tmp_enegs(2) * cut_factors(1) ) 
-                
-                end if
-             end select
-
-          else if(n_targets > 2)then
-
-             ! If the number of targets is greater than 2,
-             ! we have found a many-body potential.
-             ! Make a note that we must also evaluate the many-body terms.
-             many_bodies_found = .true.
-
-          end if ! n_targets == 2
-
-       end if ! is_active
-       end if ! cutoff
-    end do ! k
-
-  end subroutine core_evaluate_local_doublet
-
-
-
-
-  ! Evaluates the interactions affecting three atoms.
+  ! Evaluates the local force affecting two atoms. (Rearranged internally.)
   !
   ! *n_atoms total number of atoms in the system
   ! *index1 index of the atom 1
   ! *index2 index of the atom 2
-  ! *index3 index of the atom 3
-  ! *atom_triplet the atoms that are targeted
-  ! *test_index1 if 1, test if the ineraction targets atom1; similarly for 2, 3
-  ! *test_index2 if 1, test if the ineraction targets atom1; similarly for 2, 3
+  ! *atom_doublet the atoms that are targeted
+  ! *test_index1 if 1, test if the interaction targets atom1; similarly for 2
   ! *interaction_indices the interactions targeting the given atoms
-  ! *separations distance vector from 1 to 2 and 2 to 3 as an array
-  ! *directions unit vector from 1 to 2 and 2 to 3 as an array
-  ! *distances distance from 1 to 2 and 2 to 3 as an array
-  ! *calculation_type the type of information requested
-  ! *energy calculated energy
+  ! *separations distance vector from 1 to 2, as an array
+  ! *directions unit vector from 1 to 2, as an array
+  ! *distances distance from 1 to 2, as an array
   ! *forces calculated forces
   ! *stress calculated stress
-  ! *enegs calculated electronegativities
   ! *many_bodies_found returns true if the loop finds an interaction with 3 or more targets
-  subroutine core_evaluate_local_triplet(n_atoms, &
-       atom_triplet, &
-       index1, index2, index3, &
-       test_index1, test_index2, &
+  subroutine core_evaluate_local_doublet_forces_B( &
+       atom_doublet, &
+       index1, index2, &
+       test_index1, &
        interaction_indices, &
        separations, directions, distances, &
-       calculation_type,energy,forces,enegs,stress, &
-       many_bodies_found)
+       forces,stress, &
+       many_bodies_found, &
+       manybody_indices, &
+       n_manybody)
     implicit none
-    integer, intent(in) :: calculation_type, n_atoms, index1, index2, index3, test_index1, test_index2
-    integer, pointer :: interaction_indices(:)
-    double precision, intent(out) :: energy, forces(3,n_atoms), enegs(n_atoms), stress(6)
-    double precision, intent(in) :: separations(3,2), directions(3,2), distances(2)
+    integer, intent(in) :: index1, index2, test_index1
+    integer, intent(out) :: n_manybody
+    integer, pointer :: interaction_indices(:), manybody_indices(:)
+    double precision, intent(inout) :: forces(:,:), stress(6)
+    type(atom), intent(in) :: atom_doublet(2)
+    double precision, intent(in) :: separations(3,1), directions(3,1), distances(1)
     logical, intent(out) :: many_bodies_found
-    type(atom), intent(in) :: atom_triplet(3)
-
-    type(atom) :: atom1, atom2, atom3
-    integer :: k, n_targets
+    
+    type(atom) :: atom1, atom2
+    integer :: k, n_targets, index_pair(2), n_atoms
     type(potential) :: interaction
-    double precision :: bo_factors(n_atoms), bo_sums(n_atoms), bo_gradients(3,n_atoms,3), &
-         tmp_energy, tmp_forces(3,3), tmp_enegs(3), &
-         cut_factors(2), cut_gradients(3,2), &
-         triplet_forces(3,3), bo_virial(6,3)
+    double precision :: &
+         tmp_energy, tmp_forces(3,2), tmp_enegs(2), &
+         cut_factors(1), cut_gradients(3,1), &
+         pair_forces(3,2), bo_virial(6,2), &
+         pair_bo_sums(2), pair_bo_factors(2), &
+         pair_bo_virial(6,2)
     logical :: is_active
 
+    n_atoms = size(atoms)
     many_bodies_found = .false.
-    atom1 = atom_triplet(1)
-    atom2 = atom_triplet(2)
-    atom3 = atom_triplet(3)
-
-    ! loop over the potentials affecting atom1
+    n_manybody = 0
+    atom1 = atom_doublet(1)
+    atom2 = atom_doublet(2)
+    index_pair = (/ index1, index2 /)
+    
+    ! loop over potentials affecting atom1
     do k = 1, size(interaction_indices)
 
        interaction = interactions(interaction_indices(k))
-       call get_number_of_targets_of_potential_index(interaction%type_index,&
-            n_targets) ! in Potentials.f90
-       call potential_affects_atom(interaction,atom_triplet(test_index1),is_active,2) ! in Potentials.f90
 
        ! filter the potentials by:
        ! is atom2 affected by the potential,
-       ! is atom3 affected by the potential,
-       ! is it a 3-body potential
-       if( is_active .and. n_targets == 3 .and. interaction%cutoff > distances(1) )then
-          call potential_affects_atom(interaction,atom_triplet(test_index2),is_active,3)  ! in Potentials.f90
-          if( is_active )then
+       ! is it a 2-body potential
+       if( interaction%cutoff > distances(1) )then 
+       call potential_affects_atom(interaction,atom_doublet(test_index1),is_active,2) ! in Potentials.f90
+       if( is_active )then 
+          call get_number_of_targets_of_potential_index(interaction%type_index,&
+               n_targets) ! in Potentials.f90
+          if( n_targets == 2 )then
 
-             if( interaction%cutoff > distances(2) )then
+             !****************************!
+             ! 2-body force (atom1-atom2) !
+             !****************************!
+             
+             ! We will need the energy contribution from atom1-atom2
+             ! interaction if smooth cutoffs or bond factors are used,
+             ! since we are mulplying the potential.
+             if((interaction%pot_index > -1) .or. &
+                  interaction%smoothened)then
+                call evaluate_energy(2,interaction%n_product,separations(1:3,1),distances(1),&
+                     interaction,tmp_energy,atom_doublet) ! in Potentials.f90
+             else
+                tmp_energy = 0.d0
+             end if
+             
+             ! If a smooth cutoff is present, we add the
+             ! contribution it brings:
+             ! 
+             ! V = \sum_ij v_ij f(r_ij)
+             ! F_a = - \nabla_a V 
+             !     = - \sum_ij v_ij f'(r_ij) (\nabla_a r_ij) + (\nabla_a v_ij) f(r_ij) 
+             !     = - \sum_ij v_ij f'(r_ij) (\nabla_a r_ij) + f_a,ij f(r_ij)
+             !
+             if(interaction%smoothened)then
+                ! get f(r_ij)
+                call smoothening_factor(distances(1),&
+                     interaction%cutoff,interaction%soft_cutoff,&
+                     cut_factors(1)) ! in Potentials.f90
+                ! get f'(r_ij) (\nabla_a r_ij)
+                call smoothening_gradient(directions(1:3,1),distances(1),&
+                     interaction%cutoff,interaction%soft_cutoff,&
+                     cut_gradients(1:3,1)) ! in Potentials.f90
+             else
+                cut_factors(1) = 1.d0
+                cut_gradients(1:3,1) = 0.d0
+             end if
+             
+             ! If there is a bond order factor associated with the potential,
+             ! we add the contribution is brings:
+             !
+             ! V = \sum_ij b_ij v_ij
+             ! b_ij = (b_i + b_j) / 2 + B_ij
+             ! F_a = - \nabla_a V 
+             !     = - \sum_ij (\nabla_a b_ij) v_ij + b_ij (\nabla_a v_ij)
+             !     = - \sum_ij (\nabla_a b_ij) v_ij + b_ij f_a,ij
+             !
+             if(interaction%pot_index > -1)then
 
+                ! get B_ij and \nabla_a B_ij for this ij (not precalculated)
+                ! this is 
+                ! B_ij = (B*_ij + B*_ji) / 2
+                call core_calculate_pair_bond_order_factor(index_pair, &
+                     separations(1:3,1), distances(1), directions(1:3,1), &
+                     interaction%pot_index, &
+                     pair_bo_sums(1:2))
+                call core_post_process_pair_bond_order_factor(atom1, &
+                     interaction%pot_index, &
+                     pair_bo_sums(1), &
+                     pair_bo_factors(1))
+                call core_post_process_pair_bond_order_factor(atom2, &
+                     interaction%pot_index, &
+                     pair_bo_sums(2), &
+                     pair_bo_factors(2))
 
-                ! differentiate between energy, force, and electronegativity evaluation
-                select case(calculation_type)
-                case(energy_evaluation_index)
+                ! get b_i (for all i, they have been precalculated)
+                call core_get_bond_order_factors(interaction%pot_index,&
+                     bo_factors)
+                
+                if(.false.)then ! slow debug version where all gradients are first calculated
 
-                   !***********************************!
-                   ! 3-body energy (atom1-atom2-atom3) !
-                   !***********************************!
+                   ! get (\nabla_a b_i) (for all a)
+                   call core_get_bond_order_gradients(interaction%pot_index,&
+                        index1,& ! atom index
+                        1, & ! slot_index
+                        bo_gradients(1:3,1:n_atoms,1), &
+                        bo_virial(1:6,1))
+                   ! get (\nabla_a b_j) (for all a)
+                   call core_get_bond_order_gradients(interaction%pot_index,&
+                        index2,& ! atom index
+                        2, & ! slot_index
+                        bo_gradients(1:3,1:n_atoms,2), &
+                        bo_virial(1:6,2))
 
 
-                   ! If there is a bond order factor associated with the potential,
-                   ! we add the contribution is brings:
-                   !
-                   ! V = \sum_ijk b_ijk v_ijk
-                   ! b_ijk = (b_i + b_j + b_k) / 3
-                   if(interaction%pot_index > -1)then
-                      ! get b_i (for all i, they have been precalculated)
-                      call core_get_bond_order_factors(interaction%pot_index,&
-                           bo_factors)
-                   else
-                      bo_factors = 1.d0
-                   end if
+                   call core_calculate_pair_bond_order_gradients(index_pair, &
+                        separations(1:3,1), distances(1), directions(1:3,1), &
+                        interaction%pot_index, &                        
+                        pair_bo_sums(1:2), &
+                        bo_gradients(1:3,1:n_atoms,3:4), &
+                        pair_bo_virial(1:6,1:2))
 
-                   ! If a smooth cutoff is present, we add the
-                   ! contribution it brings:
-                   ! 
-                   ! V = \sum_ijk v_ijk f(r_ij) f(r_ik)
-                   if(interaction%smoothened)then
-                      ! get f(r_ij)
-                      call smoothening_factor(distances(1),&
-                           interaction%cutoff,interaction%soft_cutoff,&
-                           cut_factors(1))
-                      ! get f(r_ik)
-                      call smoothening_factor(distances(2),&
-                           interaction%cutoff,interaction%soft_cutoff,&
-                           cut_factors(2))
-                   else
-                      cut_factors(1:2) = 1.d0
-                   end if
+                   ! Add the bond order gradient terms involving the 
+                   ! atom1-atom2 energy for all atoms.
+                   ! That is, add the (\nabla_a b_ij) v_ij term with 
+                   ! the given ij (atom1,atom2) for all a.
+                   forces(1:3,1:n_atoms) = forces(1:3,1:n_atoms) &
+                        - tmp_energy*cut_factors(1)*&
+                        (bo_gradients(1:3,1:n_atoms,1) + bo_gradients(1:3,1:n_atoms,2) + &
+                        bo_gradients(1:3,1:n_atoms,3) + bo_gradients(1:3,1:n_atoms,4))*0.5d0
 
-                   ! evaluate the 3-body energy involving atom2-atom1-atom3 interaction
-                   call evaluate_energy(3,interaction%n_product,separations(1:3,1:2),distances(1:2),&
-                        interaction,tmp_energy,atom_triplet)
+                   ! Add the contribution of bond order gradients to the stress tensor
+                   stress(1:6) = stress(1:6) - tmp_energy*cut_factors(1)* &
+                        (bo_virial(1:6,1) + bo_virial(1:6,2) + pair_bo_virial(1:6,1) + pair_bo_virial(1:6,2))*0.5d0
 
-                   ! add the term: b_ijk v_ijk f(r_ij) f(r_ik)
-                   energy = energy + tmp_energy*cut_factors(1)*cut_factors(2)*&
-                        (bo_factors(index1)+bo_factors(index2)+bo_factors(index3))/3.d0
+                else
+                   call core_add_bond_order_forces( &
+                        interaction%pot_index, index1, 0.5d0*tmp_energy*cut_factors(1), &
+                        forces, stress )
 
-                case(force_evaluation_index)
+                   call core_add_bond_order_forces( &
+                        interaction%pot_index, index2, 0.5d0*tmp_energy*cut_factors(1), &
+                        forces, stress )
 
-                   !**************!
-                   ! 3-body force !
-                   !**************!
+                   call core_add_pair_bond_order_forces( &
+                        !atom_doublet, &
+                        index1, index2, &
+                        interaction, 0.5d0*tmp_energy*cut_factors(1), &
+                        separations(1:3,1), directions(1:3,1), distances(1), &
+                        interaction%pot_index, pair_bo_sums, pair_bo_factors, &
+                        forces, stress )
 
+                end if
 
-                   ! We will need the energy contribution 
-                   ! if smooth cutoffs or bond factors are used,
-                   ! since we are mulplying the potential.
-                   if((interaction%pot_index > -1) .or. &
-                        interaction%smoothened)then
-                      call evaluate_energy(3,interaction%n_product,separations(1:3,1:2),distances(1:2),&
-                           interaction,tmp_energy,atom_triplet) ! in Potentials.f90
-                   else
-                      tmp_energy = 0.d0
-                   end if
+             !else
+                !bo_factors = 1.d0
+                !bo_sums = 0.d0
+                !bo_gradients = 0.d0
+             end if
+             
+             ! evaluate the 2-body force involving atom1-atom2 interaction
+             call evaluate_forces(2,interaction%n_product,separations(1:3,1),distances(1),&
+                  interaction,tmp_forces(1:3,1:2),atom_doublet) ! in Potentials.f90
+             
+             if(interaction%pot_index > -1)then
 
-                   ! If a smooth cutoff is present, we add the
-                   ! contribution it brings:
-                   ! 
-                   ! V = \sum_ijk v_ijk f(r_ij) f(r_ik)
-                   ! F_a = - \nabla_a V 
-                   !     = - \sum_ij ( v_ij f'(r_ij) f(r_ik) (\nabla_a r_ij) + 
-                   !                   v_ij f(r_ij) f'(r_ik) (\nabla_a r_ik) +
-                   !                   (\nabla_a v_ij) f(r_ij) f(r_ik) )
-                   !
-                   if(interaction%smoothened)then
-                      ! get f(r_ij)
-                      call smoothening_factor(distances(1),&
-                           interaction%cutoff,interaction%soft_cutoff,&
-                           cut_factors(1)) ! in Potentials.f90
-                      ! get f'(r_ij) (\nabla_a r_ij)
-                      call smoothening_gradient(directions(1:3,1),distances(1),&
-                           interaction%cutoff,interaction%soft_cutoff,&
-                           cut_gradients(1:3,1)) ! in Potentials.f90 
-                      ! get f(r_jk)
-                      call smoothening_factor(distances(2),&
-                           interaction%cutoff,interaction%soft_cutoff,&
-                           cut_factors(2)) ! in Potentials.f90
-                      ! get f'(r_jk) (\nabla_a r_jk)
-                      call smoothening_gradient(directions(1:3,2),distances(2),&
-                           interaction%cutoff,interaction%soft_cutoff,&
-                           cut_gradients(1:3,2)) ! in Potentials.f90
-                   else
-                      cut_factors(1:2) = 1.d0
-                      cut_gradients(1:3,1:2) = 0.d0
-                   end if
+                ! force on atom 1:                 
+                pair_forces(1:3,1) = ( tmp_forces(1:3,1) * cut_factors(1) + &
+                     tmp_energy * cut_gradients(1:3,1) ) * &
+                     ( bo_factors(index1) + bo_factors(index2) + &
+                     pair_bo_factors(1) + pair_bo_factors(2) ) * 0.5d0
+                
+                ! force on atom 2:
+                pair_forces(1:3,2) = ( tmp_forces(1:3,2) * cut_factors(1) - &
+                     tmp_energy * cut_gradients(1:3,1) ) * &
+                     ( bo_factors(index1) + bo_factors(index2) + &
+                     pair_bo_factors(1) + pair_bo_factors(2) ) * 0.5d0
+             else
+                pair_forces(1:3,1) = ( tmp_forces(1:3,1) * cut_factors(1) + &
+                     tmp_energy * cut_gradients(1:3,1) )
+                pair_forces(1:3,2) = ( tmp_forces(1:3,2) * cut_factors(1) - &
+                     tmp_energy * cut_gradients(1:3,1) )
+             end if
+             
+             forces(1:3,index1) = forces(1:3,index1) + pair_forces(1:3,1)
+             forces(1:3,index2) = forces(1:3,index2) + pair_forces(1:3,2)
+             
+             !***************!
+             ! stress tensor !
+             !***************!
+             
+             ! s_xx, s_yy, s_zz, s_yz, s_xz, s_xy:
+             stress(1) = stress(1) + separations(1,1) * pair_forces(1,2)
+             stress(2) = stress(2) + separations(2,1) * pair_forces(2,2)
+             stress(3) = stress(3) + separations(3,1) * pair_forces(3,2)
+             stress(4) = stress(4) + separations(2,1) * pair_forces(3,2)
+             stress(5) = stress(5) + separations(1,1) * pair_forces(3,2)
+             stress(6) = stress(6) + separations(1,1) * pair_forces(2,2)
+             
+          else if(n_targets > 2)then
 
-                   ! If there is a bond order factor associated with the potential,
-                   ! we add the contribution is brings:
-                   !
-                   ! V = \sum_ijk b_ijk v_ijk
-                   ! b_ijk = (b_i + b_j + b_k) / 3
-                   ! F_a = - \nabla_a V 
-                   !     = - \sum_ijk (\nabla_a b_ijk) v_ijk + b_ijk (\nabla_a v_ijk)
-                   !     = - \sum_ijk (\nabla_a b_ijk) v_ijk + b_ij f_a,ijk
-                   !
-                   if(interaction%pot_index > -1)then
-                      ! get b_i (for all i, they have been precalculated)
-                      call core_get_bond_order_factors(interaction%pot_index,&
-                           bo_factors)
-                      ! get (\nabla_a b_i) (for all a)
-                      call core_get_bond_order_gradients(interaction%pot_index,&
-                           index1,& ! atom index
-                           1, & ! slot_index
-                           bo_gradients(1:3,1:n_atoms,1), &
-                           bo_virial(1:6,1))
-                      ! get (\nabla_a b_j) (for all a)
-                      call core_get_bond_order_gradients(interaction%pot_index,&
-                           index2,& ! atom index
-                           2, & ! slot_index
-                           bo_gradients(1:3,1:n_atoms,2), &
-                           bo_virial(1:6,2))
-                      ! get (\nabla_a b_k) (for all a)
-                      call core_get_bond_order_gradients(interaction%pot_index,&
-                           index3,& ! atom index
-                           3, & ! slot_index
-                           bo_gradients(1:3,1:n_atoms,3), &
-                           bo_virial(1:6,3))
+             ! If the number of targets is greater than 2,
+             ! we have found a many-body potential.
+             ! Make a note that we must also evaluate the many-body terms.
+             many_bodies_found = .true.
+             n_manybody = n_manybody + 1
+             manybody_indices(n_manybody) = interaction_indices(k)
 
-                      ! Add the bond order gradient terms involving the 
-                      ! atom2-atom1-atom3 energy for all atoms.
-                      ! That is, add the (\nabla_a b_ijk) v_ijk term with 
-                      ! the given ijk (atom2,atom1,atom3) for all a.
-                      forces(1:3,1:n_atoms) = forces(1:3,1:n_atoms) &
-                           - tmp_energy*cut_factors(1)*cut_factors(2)*&
-                           ( bo_gradients(1:3,1:n_atoms,1) &
-                           + bo_gradients(1:3,1:n_atoms,2) &
-                           + bo_gradients(1:3,1:n_atoms,3) )/3.d0
+          end if ! n_targets == 2
 
-                      stress(1:6) = stress(1:6) - tmp_energy*cut_factors(1)*cut_factors(2)*&
-                           ( bo_virial(1:6,1) &
-                           + bo_virial(1:6,2) &
-                           + bo_virial(1:6,3) )/3.d0
+       end if ! is_active
+       end if ! cutoff
+    end do ! k
 
-                   else
-                      !bo_factors = 1.d0
-                      !bo_sums = 0.d0
-                      !bo_gradients = 0.d0
-                   end if
+  end subroutine core_evaluate_local_doublet_forces_B
 
-                   ! evaluate the 3-body force
-                   call evaluate_forces(3,interaction%n_product,separations(1:3,1:2),distances(1:2),interaction,&
-                        tmp_forces(1:3,1:3),atom_triplet) ! in Potentials.f90
 
 
-                   if(interaction%pot_index > -1)then
-                    ! force on atom 1:
-                    triplet_forces(1:3,1) = ( tmp_forces(1:3,1)*cut_factors(1)*cut_factors(2) + &
-                        cut_gradients(1:3,1)*cut_factors(2)*tmp_energy ) * &
-                        ( bo_factors(index1) &
-                        + bo_factors(index2) &
-                        + bo_factors(index3) )/3.d0
-
-                    ! force on atom 2:
-                    triplet_forces(1:3,2) = ( tmp_forces(1:3,2)*cut_factors(1)*cut_factors(2) + &
-                        (-cut_gradients(1:3,1)*cut_factors(2) + &
-                        cut_gradients(1:3,2)*cut_factors(1)) * tmp_energy ) * &
-                        ( bo_factors(index1) &
-                        + bo_factors(index2) &
-                        + bo_factors(index3) )/3.d0
-
-                    ! force on atom 3:
-                    triplet_forces(1:3,3) = ( tmp_forces(1:3,3)*cut_factors(1)*cut_factors(2) - &
-                        cut_gradients(1:3,2)*cut_factors(1)*tmp_energy ) * &
-                        ( bo_factors(index1) &
-                        + bo_factors(index2) &
-                        + bo_factors(index3) )/3.d0
-                   else
-                    ! force on atom 1:
-                    triplet_forces(1:3,1) = ( tmp_forces(1:3,1)*cut_factors(1)*cut_factors(2) + &
-                        cut_gradients(1:3,1)*cut_factors(2)*tmp_energy ) 
+  ! Evaluates the local electronegativity affecting two atoms. (Rearranged internally.)
+  !
+  ! *index1 index of the atom 1
+  ! *index2 index of the atom 2
+  ! *atom_doublet the atoms that are targeted
+  ! *test_index1 if 1, test if the ineraction targets atom1; similarly for 2
+  ! *interaction_indices the interactions targeting the given atoms
+  ! *separations distance vector from 1 to 2, as an array
+  ! *directions unit vector from 1 to 2, as an array
+  ! *distances distance from 1 to 2, as an array
+  ! *enegs calculated electronegativities
+  ! *many_bodies_found returns true if the loop finds an interaction with 3 or more targets
+  subroutine core_evaluate_local_doublet_electronegativities_B(atom_doublet, &
+       index1, index2, &
+       test_index1, &
+       interaction_indices, &
+       separations, directions, distances, &
+       enegs, &
+       many_bodies_found, &
+       manybody_indices, &
+       n_manybody)
+    implicit none
+    integer, intent(in) :: index1, index2, test_index1
+    integer, intent(out) :: n_manybody
+    integer, pointer :: interaction_indices(:), manybody_indices(:)
+    double precision, intent(inout) :: enegs(:)
+    type(atom), intent(in) :: atom_doublet(2)
+    double precision, intent(in) :: separations(3,1), directions(3,1), distances(1)
+    logical, intent(out) :: many_bodies_found
+    
+    type(atom) :: atom1, atom2
+    integer :: k, n_targets, index_pair(2), n_atoms
+    type(potential) :: interaction
+    double precision :: tmp_energy, tmp_forces(3,2), tmp_enegs(2), &
+         cut_factors(1), &
+         pair_forces(3,2), bo_virial(6,2), &
+         pair_bo_sums(2), pair_bo_factors(2)
+    logical :: is_active
 
-                    ! force on atom 2:
-                    triplet_forces(1:3,2) = ( tmp_forces(1:3,2)*cut_factors(1)*cut_factors(2) + &
-                        (-cut_gradients(1:3,1)*cut_factors(2) + &
-                        cut_gradients(1:3,2)*cut_factors(1)) * tmp_energy ) 
+    n_atoms = size(atoms)
+    many_bodies_found = .false.
+    n_manybody = 0
 
-                    ! force on atom 3:
-                    triplet_forces(1:3,3) = ( tmp_forces(1:3,3)*cut_factors(1)*cut_factors(2) - &
-                        cut_gradients(1:3,2)*cut_factors(1)*tmp_energy ) 
-                   
-                   end if
+    atom1 = atom_doublet(1)
+    atom2 = atom_doublet(2)
+    index_pair = (/ index1, index2 /)
 
-                   forces(1:3,index1) = forces(1:3,index1) + triplet_forces(1:3,1)
-                   forces(1:3,index2) = forces(1:3,index2) + triplet_forces(1:3,2)
-                   forces(1:3,index3) = forces(1:3,index3) + triplet_forces(1:3,3)
-                        
-                   !***************!
-                   ! stress tensor !
-                   !***************!
-                   
-                   ! s_xx, s_yy, s_zz, s_yz, s_xz, s_xy:
-                   stress(1) = stress(1) + separations(1,1) * triplet_forces(1,2) &
-                        + (separations(1,1) + separations(1,2)) * triplet_forces(1,3)
-                   stress(2) = stress(2) + separations(2,1) * triplet_forces(2,2) &
-                        + (separations(2,1) + separations(2,2)) * triplet_forces(2,3)
-                   stress(3) = stress(3) + separations(3,1) * triplet_forces(3,2) &
-                        + (separations(3,1) + separations(3,2)) * triplet_forces(3,3)
-                   stress(4) = stress(4) + separations(2,1) * triplet_forces(3,2) &
-                        + (separations(2,1) + separations(2,2)) * triplet_forces(3,3)
-                   stress(5) = stress(5) + separations(1,1) * triplet_forces(3,2) &
-                        + (separations(1,1) + separations(1,2)) * triplet_forces(3,3)
-                   stress(6) = stress(6) + separations(1,1) * triplet_forces(2,2) &
-                        + (separations(1,1) + separations(1,2)) * triplet_forces(2,3)
+    ! loop over potentials affecting atom1
+    do k = 1, size(interaction_indices)
 
-                case(electronegativity_evaluation_index)
+       interaction = interactions(interaction_indices(k))
 
-                   !**********************************************!
-                   ! 3-body electronegativity (atom1-atom2-atom3) !
-                   !**********************************************!
+       ! filter the potentials by:
+       ! is atom2 affected by the potential,
+       ! is it a 2-body potential
+       if( interaction%cutoff > distances(1) )then 
+          call potential_affects_atom(interaction,atom_doublet(test_index1),is_active,2) ! in Potentials.f90
+          if( is_active )then 
+             call get_number_of_targets_of_potential_index(interaction%type_index,&
+                  n_targets) ! in Potentials.f90
+             if( n_targets == 2 )then
 
-                   ! If a smooth cutoff is present, we add the
-                   ! contribution it brings:
-                   if(interaction%smoothened)then
-                      ! get f(r_ij)
-                      call smoothening_factor(distances(1),&
-                           interaction%cutoff,interaction%soft_cutoff,&
-                           cut_factors(1)) ! in Potentials.f90
-                      ! get f(r_ik)
-                      call smoothening_factor(distances(2),&
-                           interaction%cutoff,interaction%soft_cutoff,&
-                           cut_factors(2)) ! in Potentials.f90
-                   else
-                      cut_factors(1:2) = 1.d0
-                   end if
 
-                   ! If there is a bond order factor associated with the potential,
-                   ! we add the contribution is brings:
-                   if(interaction%pot_index > -1)then
-                      ! get b_i (for all i, they have been precalculated)
-                      call core_get_bond_order_factors(interaction%pot_index,&
-                           bo_factors) ! in Potentials.f90
-                   else
-                      bo_factors = 1.d0
-                   end if
+                !****************************************!
+                ! 2-body electronegativity (atom1-atom2) !
+                !****************************************!
 
-                   ! evaluate the 3-body e-neg involving atom2-atom1-atom3 interaction
-                   call evaluate_electronegativity(3,interaction%n_product,separations(1:3,1:2),&
-                        distances(1:2),interaction,&
-                        tmp_enegs(1:3),atom_triplet) ! in Potentials.f90
+                ! If a smooth cutoff is present, we add the
+                ! contribution it brings:
+                if(interaction%smoothened)then
+                   ! get f(r_ij)
+                   call smoothening_factor(distances(1),&
+                        interaction%cutoff,interaction%soft_cutoff,&
+                        cut_factors(1)) ! in Potentials.f90
+                else
+                   cut_factors(1) = 1.d0
+                end if
 
-                   ! e-neg on atom 1:
-                   enegs(index1) = enegs(index1) + &
-                        ( tmp_enegs(1)*cut_factors(1)*cut_factors(2) ) * &
-                        ( bo_factors(index1) &
-                        + bo_factors(index2) &
-                        + bo_factors(index3) )/3.d0
+                ! If there is a bond order factor associated with the potential,
+                ! we add the contribution is brings:
+                if(interaction%pot_index > -1)then
+                   ! get b_i (for all i, they have been precalculated)
+                   call core_get_bond_order_factors(interaction%pot_index,&
+                        bo_factors)
 
-                   ! e-neg on atom 2:
-                   enegs(index2) = enegs(index2) + &
-                        ( tmp_enegs(2)*cut_factors(1)*cut_factors(2) ) * &
-                        ( bo_factors(index1) &
-                        + bo_factors(index2) &
-                        + bo_factors(index3) )/3.d0
+                   ! get B_ij and \nabla_a B_ij for this ij (not precalculated)
+                   ! this is 
+                   ! B_ij = (B*_ij + B*_ji) / 2
+                   call core_calculate_pair_bond_order_factor(index_pair, &
+                        separations(1:3,1), distances(1), directions(1:3,1), &
+                        interaction%pot_index, &
+                        pair_bo_sums(1:2))
+                   call core_post_process_pair_bond_order_factor(atom1, &
+                        interaction%pot_index, &
+                        pair_bo_sums(1), &
+                        pair_bo_factors(1))
+                   call core_post_process_pair_bond_order_factor(atom2, &
+                        interaction%pot_index, &
+                        pair_bo_sums(2), &
+                        pair_bo_factors(2))
 
-                   ! e-neg on atom 3:
-                   enegs(index3) = enegs(index3) + &
-                        ( tmp_enegs(3)*cut_factors(1)*cut_factors(2) ) * &
-                        ( bo_factors(index1) &
-                        + bo_factors(index2) &
-                        + bo_factors(index3) )/3.d0
+                else
 
+                end if
 
-                end select
+                ! evaluate the 2-body e-neg involving atom1-atom2 interaction
+                call evaluate_electronegativity(2,interaction%n_product,separations(1:3,1),distances(1),&
+                     interaction,tmp_enegs(1:2),atom_doublet) ! in Potentials.f90
 
 
-             end if ! interaction%cutoff > distances(2)
+                if(interaction%pot_index > -1)then
+                    ! e-neg on atom 1:
+                    enegs(index1) = enegs(index1) + &
+                     ( tmp_enegs(1) * cut_factors(1) ) * &
+                     ( bo_factors(index1) +  bo_factors(index2) + &
+                     pair_bo_factors(1) + pair_bo_factors(2) ) * 0.5d0
 
-          end if ! is_active
-       else if(n_targets > 3)then
+                    ! e-neg on atom 2:
+                    enegs(index2) = enegs(index2) + &
+                     ( tmp_enegs(2) * cut_factors(1) ) * &
+                     ( bo_factors(index1) +  bo_factors(index2) + &
+                     pair_bo_factors(1) + pair_bo_factors(2)  ) * 0.5d0
+                else
+                    ! e-neg on atom 1:
+                    enegs(index1) = enegs(index1) + &
+                     ( tmp_enegs(1) * cut_factors(1) ) 
 
-          many_bodies_found = .true.
+                    ! e-neg on atom 2:
+                    enegs(index2) = enegs(index2) + &
+                     ( tmp_enegs(2) * cut_factors(1) ) 
+                
+                end if
 
-       end if ! is_active .and. n_targets == 3
+          else if(n_targets > 2)then
 
-    end do ! k = 1, size(interaction_indices)
+             ! If the number of targets is greater than 2,
+             ! we have found a many-body potential.
+             ! Make a note that we must also evaluate the many-body terms.
+             many_bodies_found = .true.
+             n_manybody = n_manybody + 1
+             manybody_indices(n_manybody) = interaction_indices(k)
 
+          end if ! n_targets == 2
 
-  end subroutine core_evaluate_local_triplet
+       end if ! is_active
+       end if ! cutoff
+    end do ! k
 
+  end subroutine core_evaluate_local_doublet_electronegativities_B
 
 
 
 
-  ! Evaluates the interactions affecting three atoms. (Rearranged internally.)
+  ! Evaluates the local electronegativity affecting two atoms.
   !
-  ! *n_atoms total number of atoms in the system
   ! *index1 index of the atom 1
   ! *index2 index of the atom 2
-  ! *index3 index of the atom 3
-  ! *atom_triplet the atoms that are targeted
-  ! *test_index1 if 1, test if the ineraction targets atom1; similarly for 2, 3
-  ! *test_index2 if 1, test if the ineraction targets atom1; similarly for 2, 3
+  ! *atom_doublet the atoms that are targeted
+  ! *test_index1 if 1, test if the ineraction targets atom1; similarly for 2
   ! *interaction_indices the interactions targeting the given atoms
-  ! *separations distance vector from 1 to 2 and 2 to 3 as an array
-  ! *directions unit vector from 1 to 2 and 2 to 3 as an array
-  ! *distances distance from 1 to 2 and 2 to 3 as an array
-  ! *calculation_type the type of information requested
-  ! *energy calculated energy
-  ! *forces calculated forces
-  ! *stress calculated stress
+  ! *separations distance vector from 1 to 2, as an array
+  ! *directions unit vector from 1 to 2, as an array
+  ! *distances distance from 1 to 2, as an array
   ! *enegs calculated electronegativities
   ! *many_bodies_found returns true if the loop finds an interaction with 3 or more targets
-  subroutine core_evaluate_local_triplet_B(atom_triplet, &
-       index1, index2, index3, &
-       test_index1, test_index2, &
-       !interaction_indices, &
+  subroutine core_evaluate_local_doublet_electronegativities(n_atoms, &
+       atom_doublet, &
+       index1, index2, &
+       test_index1, &
+       interaction_indices, &
        separations, directions, distances, &
-       calculation_type,energy,forces,enegs,stress, &
-       many_bodies_found, &
-       manybody_indices, &
-       n_manybody )
+       enegs, &
+       many_bodies_found)
     implicit none
-    integer, intent(in) :: calculation_type, index1, index2, index3, &
-         test_index1, test_index2, n_manybody
-    !integer, pointer :: interaction_indices(:), manybody_indices(:)
-    integer, pointer :: manybody_indices(:)
-    double precision, intent(inout) :: energy, forces(:,:), enegs(:), stress(6)
-    double precision, intent(in) :: separations(3,2), directions(3,2), distances(2)
+    integer, intent(in) :: n_atoms, index1, index2, test_index1
+    integer, pointer :: interaction_indices(:)
+    double precision, intent(inout) :: enegs(n_atoms)
+    type(atom), intent(in) :: atom_doublet(2)
+    double precision, intent(in) :: separations(3,1), directions(3,1), distances(1)
     logical, intent(out) :: many_bodies_found
-    type(atom), intent(in) :: atom_triplet(3)
+    
+    type(atom) :: atom1, atom2
+    integer :: k, n_targets, index_pair(2)
+    type(potential) :: interaction
+    double precision :: bo_factors(n_atoms), bo_sums(n_atoms), bo_gradients(3,n_atoms,3), &
+         tmp_energy, tmp_forces(3,2), tmp_enegs(2), &
+         cut_factors(1), &
+         pair_forces(3,2), bo_virial(6,2), &
+         pair_bo_sums(2), pair_bo_factors(2)
+    logical :: is_active
 
-    type(atom) :: atom1, atom2, atom3
-    integer :: k, n_targets, n_atoms
+    many_bodies_found = .false.
+    atom1 = atom_doublet(1)
+    atom2 = atom_doublet(2)
+    index_pair = (/ index1, index2 /)
+
+    ! loop over potentials affecting atom1
+    do k = 1, size(interaction_indices)
+
+       interaction = interactions(interaction_indices(k))
+
+       ! filter the potentials by:
+       ! is atom2 affected by the potential,
+       ! is it a 2-body potential
+       if( interaction%cutoff > distances(1) )then 
+       call potential_affects_atom(interaction,atom_doublet(test_index1),is_active,2) ! in Potentials.f90
+       if( is_active )then 
+          call get_number_of_targets_of_potential_index(interaction%type_index,&
+               n_targets) ! in Potentials.f90
+          if( n_targets == 2 )then
+
+
+                !****************************************!
+                ! 2-body electronegativity (atom1-atom2) !
+                !****************************************!
+
+                ! If a smooth cutoff is present, we add the
+                ! contribution it brings:
+                if(interaction%smoothened)then
+                   ! get f(r_ij)
+                   call smoothening_factor(distances(1),&
+                        interaction%cutoff,interaction%soft_cutoff,&
+                        cut_factors(1)) ! in Potentials.f90
+                else
+                   cut_factors(1) = 1.d0
+                end if
+
+                ! If there is a bond order factor associated with the potential,
+                ! we add the contribution is brings:
+                if(interaction%pot_index > -1)then
+                   ! get b_i (for all i, they have been precalculated)
+                   call core_get_bond_order_factors(interaction%pot_index,&
+                        bo_factors)
+
+                   ! get B_ij and \nabla_a B_ij for this ij (not precalculated)
+                   ! this is 
+                   ! B_ij = (B*_ij + B*_ji) / 2
+                   call core_calculate_pair_bond_order_factor(index_pair, &
+                        separations(1:3,1), distances(1), directions(1:3,1), &
+                        interaction%pot_index, &
+                        pair_bo_sums(1:2))
+                   call core_post_process_pair_bond_order_factor(atom1, &
+                        interaction%pot_index, &
+                        pair_bo_sums(1), &
+                        pair_bo_factors(1))
+                   call core_post_process_pair_bond_order_factor(atom2, &
+                        interaction%pot_index, &
+                        pair_bo_sums(2), &
+                        pair_bo_factors(2))
+
+                else
+                   !bo_factors = 1.d0
+                end if
+
+                ! evaluate the 2-body e-neg involving atom1-atom2 interaction
+                call evaluate_electronegativity(2,interaction%n_product,separations(1:3,1),distances(1),&
+                     interaction,tmp_enegs(1:2),atom_doublet) ! in Potentials.f90
+
+
+                if(interaction%pot_index > -1)then
+                    ! e-neg on atom 1:
+                    enegs(index1) = enegs(index1) + &
+                     ( tmp_enegs(1) * cut_factors(1) ) * &
+                     ( bo_factors(index1) +  bo_factors(index2) + &
+                     pair_bo_factors(1) + pair_bo_factors(2) ) * 0.5d0
+
+                    ! e-neg on atom 2:
+                    enegs(index2) = enegs(index2) + &
+                     ( tmp_enegs(2) * cut_factors(1) ) * &
+                     ( bo_factors(index1) +  bo_factors(index2) + &
+                     pair_bo_factors(1) + pair_bo_factors(2)  ) * 0.5d0
+                else
+                    ! e-neg on atom 1:
+                    enegs(index1) = enegs(index1) + &
+                     ( tmp_enegs(1) * cut_factors(1) ) 
+
+                    ! e-neg on atom 2:
+                    enegs(index2) = enegs(index2) + &
+                     ( tmp_enegs(2) * cut_factors(1) ) 
+                
+                end if
+
+          else if(n_targets > 2)then
+
+             ! If the number of targets is greater than 2,
+             ! we have found a many-body potential.
+             ! Make a note that we must also evaluate the many-body terms.
+             many_bodies_found = .true.
+
+          end if ! n_targets == 2
+
+       end if ! is_active
+       end if ! cutoff
+    end do ! k
+
+  end subroutine core_evaluate_local_doublet_electronegativities
+
+
+
+
+  ! Evaluates the interactions affecting two atoms.
+  !
+  ! *n_atoms total number of atoms in the system
+  ! *index1 index of the atom 1
+  ! *index2 index of the atom 2
+  ! *atom_doublet the atoms that are targeted
+  ! *test_index1 if 1, test if the ineraction targets atom1; similarly for 2
+  ! *interaction_indices the interactions targeting the given atoms
+  ! *separations distance vector from 1 to 2, as an array
+  ! *directions unit vector from 1 to 2, as an array
+  ! *distances distance from 1 to 2, as an array
+  ! *calculation_type the type of information requested
+  ! *energy calculated energy
+  ! *forces calculated forces
+  ! *stress calculated stress
+  ! *enegs calculated electronegativities
+  ! *many_bodies_found returns true if the loop finds an interaction with 3 or more targets
+  subroutine core_evaluate_local_doublet(n_atoms, &
+       atom_doublet, &
+       index1, index2, &
+       test_index1, &
+       interaction_indices, &
+       separations, directions, distances, &
+       calculation_type,energy,forces,enegs,stress, &
+       many_bodies_found)
+    implicit none
+    integer, intent(in) :: calculation_type, n_atoms, index1, index2, test_index1
+    integer, pointer :: interaction_indices(:)
+    double precision, intent(inout) :: energy, forces(3,n_atoms), enegs(n_atoms), stress(6)
+    type(atom), intent(in) :: atom_doublet(2)
+    double precision, intent(in) :: separations(3,1), directions(3,1), distances(1)
+    logical, intent(out) :: many_bodies_found
+    
+    type(atom) :: atom1, atom2
+    integer :: k, n_targets, index_pair(2)
     type(potential) :: interaction
-    double precision :: tmp_energy, tmp_forces(3,3), tmp_enegs(3), &
-         cut_factors(2), cut_gradients(3,2), &
-         triplet_forces(3,3), bo_virial(6,3), prefactor
+    double precision :: bo_factors(n_atoms), bo_sums(n_atoms), bo_gradients(3,n_atoms,3), &
+         tmp_energy, tmp_forces(3,2), tmp_enegs(2), &
+         cut_factors(1), cut_gradients(3,1), &
+         pair_forces(3,2), bo_virial(6,2), &
+         pair_bo_sums(2), pair_bo_factors(2), &
+         pair_bo_gradients(3,n_atoms,2), pair_bo_virial(6,2)
     logical :: is_active
 
     many_bodies_found = .false.
-    atom1 = atom_triplet(1)
-    atom2 = atom_triplet(2)
-    atom3 = atom_triplet(3)
+    atom1 = atom_doublet(1)
+    atom2 = atom_doublet(2)
+    index_pair = (/ index1, index2 /)
 
-    ! loop over the potentials affecting atom1
-    do k = 1, n_manybody !size(interaction_indices)
+    ! loop over potentials affecting atom1
+    do k = 1, size(interaction_indices)
 
-       interaction = interactions(manybody_indices(k))
-       call get_number_of_targets_of_potential_index(interaction%type_index,&
-            n_targets) ! in Potentials.f90
-       call potential_affects_atom(interaction,atom_triplet(test_index1),is_active,2) ! in Potentials.f90
+       interaction = interactions(interaction_indices(k))
 
        ! filter the potentials by:
        ! is atom2 affected by the potential,
-       ! is atom3 affected by the potential,
-       ! is it a 3-body potential
-       if( is_active .and. n_targets == 3 .and. interaction%cutoff > distances(1) )then
-          call potential_affects_atom(interaction,atom_triplet(test_index2),is_active,3)  ! in Potentials.f90
-          if( is_active )then
+       ! is it a 2-body potential
+       if( interaction%cutoff > distances(1) )then 
+       call potential_affects_atom(interaction,atom_doublet(test_index1),is_active,2) ! in Potentials.f90
+       if( is_active )then 
+          call get_number_of_targets_of_potential_index(interaction%type_index,&
+               n_targets) ! in Potentials.f90
+          if( n_targets == 2 )then
+
+             ! differentiate between energy, force, and electronegativity evaluation
+             select case(calculation_type)
+             case(energy_evaluation_index)
+
+                !*****************************!
+                ! 2-body energy (atom1-atom2) !
+                !*****************************!
+
+                ! If there is a bond order factor associated with the potential,
+                ! we add the contribution is brings:
+                !
+                ! V = \sum_ij b_ij v_ij
+                ! b_ij = (b_i + b_j) / 2 + B_ij
+                if(interaction%pot_index > -1)then
+                   ! get b_i (for all i, they have been precalculated)
+                   call core_get_bond_order_factors(interaction%pot_index,&
+                        bo_factors)
+
+                   ! get B_ij for this ij (not precalculated)
+                   ! this is 
+                   ! B_ij = (B*_ij + B*_ji) / 2
+                   call core_calculate_pair_bond_order_factor(index_pair, &
+                        separations(1:3,1), distances(1), directions(1:3,1), &
+                        interaction%pot_index, &
+                        pair_bo_sums(1:2))
+                   call core_post_process_pair_bond_order_factor(atom1, &
+                        interaction%pot_index, &
+                        pair_bo_sums(1), &
+                        pair_bo_factors(1))
+                   call core_post_process_pair_bond_order_factor(atom2, &
+                        interaction%pot_index, &
+                        pair_bo_sums(2), &
+                        pair_bo_factors(2))
+
+                else
+                   !bo_factors = 1.d0
+                end if
+
+                ! If a smooth cutoff is present, we add the
+                ! contribution it brings:
+                ! 
+                ! V = \sum_ij v_ij f(r_ij)
+                if(interaction%smoothened)then
+                   ! get f(r_ij)
+                   call smoothening_factor(distances(1),&
+                        interaction%cutoff,interaction%soft_cutoff,&
+                        cut_factors(1)) ! in Potentials.f90
+                else
+                   cut_factors(1) = 1.d0
+                end if
+
+                ! evaluate the 2-body energy involving atom1-atom2 interaction
+                call evaluate_energy(2,interaction%n_product,separations(1:3,1),distances(1),&
+                     interaction,tmp_energy,atom_doublet)  ! in Potentials.f90
+
+                ! add the term: b_ij v_ij f(rij)
+                if(interaction%pot_index > -1)then
+                    energy = energy + tmp_energy*cut_factors(1)*&
+                         (bo_factors(index1)+bo_factors(index2)+pair_bo_factors(1)+pair_bo_factors(2))*0.5d0
+                else
+                    energy = energy + tmp_energy*cut_factors(1)
+                end if
+
+             case(force_evaluation_index)
+
+                !****************************!
+                ! 2-body force (atom1-atom2) !
+                !****************************!
+
+                ! We will need the energy contribution from atom1-atom2
+                ! interaction if smooth cutoffs or bond factors are used,
+                ! since we are mulplying the potential.
+                if((interaction%pot_index > -1) .or. &
+                     interaction%smoothened)then
+                   call evaluate_energy(2,interaction%n_product,separations(1:3,1),distances(1),&
+                        interaction,tmp_energy,atom_doublet) ! in Potentials.f90
+                else
+                   tmp_energy = 0.d0
+                end if
+
+                ! If a smooth cutoff is present, we add the
+                ! contribution it brings:
+                ! 
+                ! V = \sum_ij v_ij f(r_ij)
+                ! F_a = - \nabla_a V 
+                !     = - \sum_ij v_ij f'(r_ij) (\nabla_a r_ij) + (\nabla_a v_ij) f(r_ij) 
+                !     = - \sum_ij v_ij f'(r_ij) (\nabla_a r_ij) + f_a,ij f(r_ij)
+                !
+                if(interaction%smoothened)then
+                   ! get f(r_ij)
+                   call smoothening_factor(distances(1),&
+                        interaction%cutoff,interaction%soft_cutoff,&
+                        cut_factors(1)) ! in Potentials.f90
+                   ! get f'(r_ij) (\nabla_a r_ij)
+                   call smoothening_gradient(directions(1:3,1),distances(1),&
+                        interaction%cutoff,interaction%soft_cutoff,&
+                        cut_gradients(1:3,1)) ! in Potentials.f90
+                else
+                   cut_factors(1) = 1.d0
+                   cut_gradients(1:3,1) = 0.d0
+                end if
+
+                ! If there is a bond order factor associated with the potential,
+                ! we add the contribution is brings:
+                !
+                ! V = \sum_ij b_ij v_ij
+                ! b_ij = (b_i + b_j) / 2 + B_ij
+                ! F_a = - \nabla_a V 
+                !     = - \sum_ij (\nabla_a b_ij) v_ij + b_ij (\nabla_a v_ij)
+                !     = - \sum_ij (\nabla_a b_ij) v_ij + b_ij f_a,ij
+                !
+                if(interaction%pot_index > -1)then
+                   ! get b_i (for all i, they have been precalculated)
+                   call core_get_bond_order_factors(interaction%pot_index,&
+                        bo_factors)
+                   ! get (\nabla_a b_i) (for all a)
+                   call core_get_bond_order_gradients(interaction%pot_index,&
+                        index1,& ! atom index
+                        1, & ! slot_index
+                        bo_gradients(1:3,1:n_atoms,1), &
+                        bo_virial(1:6,1))
+                   ! get (\nabla_a b_j) (for all a)
+                   call core_get_bond_order_gradients(interaction%pot_index,&
+                        index2,& ! atom index
+                        2, & ! slot_index
+                        bo_gradients(1:3,1:n_atoms,2), &
+                        bo_virial(1:6,2))
+
+
+                   ! get B_ij and \nabla_a B_ij for this ij (not precalculated)
+                   ! this is 
+                   ! B_ij = (B*_ij + B*_ji) / 2
+                   call core_calculate_pair_bond_order_factor(index_pair, &
+                        separations(1:3,1), distances(1), directions(1:3,1), &
+                        interaction%pot_index, &
+                        pair_bo_sums(1:2))
+                   call core_post_process_pair_bond_order_factor(atom1, &
+                        interaction%pot_index, &
+                        pair_bo_sums(1), &
+                        pair_bo_factors(1))
+                   call core_post_process_pair_bond_order_factor(atom2, &
+                        interaction%pot_index, &
+                        pair_bo_sums(2), &
+                        pair_bo_factors(2))
+
+                   call core_calculate_pair_bond_order_gradients(index_pair, &
+                        separations(1:3,1), distances(1), directions(1:3,1), &
+                        interaction%pot_index, &                        
+                        pair_bo_sums(1:2), &
+                        pair_bo_gradients(1:3,1:n_atoms,1:2), &
+                        pair_bo_virial(1:6,1:2))
+
+
+                   ! Add the bond order gradient terms involving the 
+                   ! atom1-atom2 energy for all atoms.
+                   ! That is, add the (\nabla_a b_ij) v_ij term with 
+                   ! the given ij (atom1,atom2) for all a.
+                   forces(1:3,1:n_atoms) = forces(1:3,1:n_atoms) &
+                        - tmp_energy*cut_factors(1)*&
+                        (bo_gradients(1:3,1:n_atoms,1) + bo_gradients(1:3,1:n_atoms,2) + &
+                        pair_bo_gradients(1:3,1:n_atoms,1) + pair_bo_gradients(1:3,1:n_atoms,2))*0.5d0
+
+                   ! Add the contribution of bond order gradients to the stress tensor
+                   stress(1:6) = stress(1:6) - tmp_energy*cut_factors(1)* &
+                        (bo_virial(1:6,1) + bo_virial(1:6,2) + pair_bo_virial(1:6,1) + pair_bo_virial(1:6,2))*0.5d0
+
+                else
+                   !bo_factors = 1.d0
+                   !bo_sums = 0.d0
+                   !bo_gradients = 0.d0
+                end if
+
+                ! evaluate the 2-body force involving atom1-atom2 interaction
+                call evaluate_forces(2,interaction%n_product,separations(1:3,1),distances(1),&
+                     interaction,tmp_forces(1:3,1:2),atom_doublet) ! in Potentials.f90
+
+                if(interaction%pot_index > -1)then
+
+                    ! force on atom 1:                 
+                    pair_forces(1:3,1) = ( tmp_forces(1:3,1) * cut_factors(1) + &
+                         tmp_energy * cut_gradients(1:3,1) ) * &
+                         ( bo_factors(index1) + bo_factors(index2) + &
+                         pair_bo_factors(1) + pair_bo_factors(2) ) * 0.5d0
+
+                    ! force on atom 2:
+                    pair_forces(1:3,2) = ( tmp_forces(1:3,2) * cut_factors(1) - &
+                         tmp_energy * cut_gradients(1:3,1) ) * &
+                         ( bo_factors(index1) + bo_factors(index2) + &
+                         pair_bo_factors(1) + pair_bo_factors(2) ) * 0.5d0
+                else
+                    pair_forces(1:3,1) = ( tmp_forces(1:3,1) * cut_factors(1) + &
+                         tmp_energy * cut_gradients(1:3,1) )
+                    pair_forces(1:3,2) = ( tmp_forces(1:3,2) * cut_factors(1) - &
+                         tmp_energy * cut_gradients(1:3,1) )
+                end if
+
+                forces(1:3,index1) = forces(1:3,index1) + pair_forces(1:3,1)
+                forces(1:3,index2) = forces(1:3,index2) + pair_forces(1:3,2)
+
+                !***************!
+                ! stress tensor !
+                !***************!
+                
+                ! s_xx, s_yy, s_zz, s_yz, s_xz, s_xy:
+                stress(1) = stress(1) + separations(1,1) * pair_forces(1,2)
+                stress(2) = stress(2) + separations(2,1) * pair_forces(2,2)
+                stress(3) = stress(3) + separations(3,1) * pair_forces(3,2)
+                stress(4) = stress(4) + separations(2,1) * pair_forces(3,2)
+                stress(5) = stress(5) + separations(1,1) * pair_forces(3,2)
+                stress(6) = stress(6) + separations(1,1) * pair_forces(2,2)
+
+             case(electronegativity_evaluation_index)
+
+                !****************************************!
+                ! 2-body electronegativity (atom1-atom2) !
+                !****************************************!
+
+                ! If a smooth cutoff is present, we add the
+                ! contribution it brings:
+                if(interaction%smoothened)then
+                   ! get f(r_ij)
+                   call smoothening_factor(distances(1),&
+                        interaction%cutoff,interaction%soft_cutoff,&
+                        cut_factors(1)) ! in Potentials.f90
+                else
+                   cut_factors(1) = 1.d0
+                end if
+
+                ! If there is a bond order factor associated with the potential,
+                ! we add the contribution is brings:
+                if(interaction%pot_index > -1)then
+                   ! get b_i (for all i, they have been precalculated)
+                   call core_get_bond_order_factors(interaction%pot_index,&
+                        bo_factors)
+
+                   ! get B_ij and \nabla_a B_ij for this ij (not precalculated)
+                   ! this is 
+                   ! B_ij = (B*_ij + B*_ji) / 2
+                   call core_calculate_pair_bond_order_factor(index_pair, &
+                        separations(1:3,1), distances(1), directions(1:3,1), &
+                        interaction%pot_index, &
+                        pair_bo_sums(1:2))
+                   call core_post_process_pair_bond_order_factor(atom1, &
+                        interaction%pot_index, &
+                        pair_bo_sums(1), &
+                        pair_bo_factors(1))
+                   call core_post_process_pair_bond_order_factor(atom2, &
+                        interaction%pot_index, &
+                        pair_bo_sums(2), &
+                        pair_bo_factors(2))
+
+                else
+                   !bo_factors = 1.d0
+                end if
+
+                ! evaluate the 2-body e-neg involving atom1-atom2 interaction
+                call evaluate_electronegativity(2,interaction%n_product,separations(1:3,1),distances(1),&
+                     interaction,tmp_enegs(1:2),atom_doublet) ! in Potentials.f90
+
+
+                if(interaction%pot_index > -1)then
+                    ! e-neg on atom 1:
+                    enegs(index1) = enegs(index1) + &
+                     ( tmp_enegs(1) * cut_factors(1) ) * &
+                     ( bo_factors(index1) +  bo_factors(index2) + &
+                     pair_bo_factors(1) + pair_bo_factors(2) ) * 0.5d0
+
+                    ! e-neg on atom 2:
+                    enegs(index2) = enegs(index2) + &
+                     ( tmp_enegs(2) * cut_factors(1) ) * &
+                     ( bo_factors(index1) +  bo_factors(index2) + &
+                     pair_bo_factors(1) + pair_bo_factors(2)  ) * 0.5d0
+                else
+                    ! e-neg on atom 1:
+                    enegs(index1) = enegs(index1) + &
+                     ( tmp_enegs(1) * cut_factors(1) ) 
+
+                    ! e-neg on atom 2:
+                    enegs(index2) = enegs(index2) + &
+                     ( tmp_enegs(2) * cut_factors(1) ) 
+                
+                end if
+             end select
+
+          else if(n_targets > 2)then
+
+             ! If the number of targets is greater than 2,
+             ! we have found a many-body potential.
+             ! Make a note that we must also evaluate the many-body terms.
+             many_bodies_found = .true.
+
+          end if ! n_targets == 2
+
+       end if ! is_active
+       end if ! cutoff
+    end do ! k
+
+  end subroutine core_evaluate_local_doublet
+
+
+
+
+  ! Evaluates the interactions affecting three atoms.
+  !
+  ! *n_atoms total number of atoms in the system
+  ! *index1 index of the atom 1
+  ! *index2 index of the atom 2
+  ! *index3 index of the atom 3
+  ! *atom_triplet the atoms that are targeted
+  ! *test_index1 if 1, test if the ineraction targets atom1; similarly for 2, 3
+  ! *test_index2 if 1, test if the ineraction targets atom1; similarly for 2, 3
+  ! *interaction_indices the interactions targeting the given atoms
+  ! *separations distance vector from 1 to 2 and 2 to 3 as an array
+  ! *directions unit vector from 1 to 2 and 2 to 3 as an array
+  ! *distances distance from 1 to 2 and 2 to 3 as an array
+  ! *calculation_type the type of information requested
+  ! *energy calculated energy
+  ! *forces calculated forces
+  ! *stress calculated stress
+  ! *enegs calculated electronegativities
+  ! *many_bodies_found returns true if the loop finds an interaction with 3 or more targets
+  subroutine core_evaluate_local_triplet(n_atoms, &
+       atom_triplet, &
+       index1, index2, index3, &
+       test_index1, test_index2, &
+       interaction_indices, &
+       separations, directions, distances, &
+       calculation_type,energy,forces,enegs,stress, &
+       many_bodies_found)
+    implicit none
+    integer, intent(in) :: calculation_type, n_atoms, index1, index2, index3, test_index1, test_index2
+    integer, pointer :: interaction_indices(:)
+    double precision, intent(out) :: energy, forces(3,n_atoms), enegs(n_atoms), stress(6)
+    double precision, intent(in) :: separations(3,2), directions(3,2), distances(2)
+    logical, intent(out) :: many_bodies_found
+    type(atom), intent(in) :: atom_triplet(3)
+
+    type(atom) :: atom1, atom2, atom3
+    integer :: k, n_targets
+    type(potential) :: interaction
+    double precision :: bo_factors(n_atoms), bo_sums(n_atoms), bo_gradients(3,n_atoms,3), &
+         tmp_energy, tmp_forces(3,3), tmp_enegs(3), &
+         cut_factors(2), cut_gradients(3,2), &
+         triplet_forces(3,3), bo_virial(6,3)
+    logical :: is_active
+
+    many_bodies_found = .false.
+    atom1 = atom_triplet(1)
+    atom2 = atom_triplet(2)
+    atom3 = atom_triplet(3)
+
+    ! loop over the potentials affecting atom1
+    do k = 1, size(interaction_indices)
+
+       interaction = interactions(interaction_indices(k))
+       call get_number_of_targets_of_potential_index(interaction%type_index,&
+            n_targets) ! in Potentials.f90
+       call potential_affects_atom(interaction,atom_triplet(test_index1),is_active,2) ! in Potentials.f90
+
+       ! filter the potentials by:
+       ! is atom2 affected by the potential,
+       ! is atom3 affected by the potential,
+       ! is it a 3-body potential
+       if( is_active .and. n_targets == 3 .and. interaction%cutoff > distances(1) )then
+          call potential_affects_atom(interaction,atom_triplet(test_index2),is_active,3)  ! in Potentials.f90
+          if( is_active )then
+
+             if( interaction%cutoff > distances(2) )then
+
+
+                ! differentiate between energy, force, and electronegativity evaluation
+                select case(calculation_type)
+                case(energy_evaluation_index)
+
+                   !***********************************!
+                   ! 3-body energy (atom1-atom2-atom3) !
+                   !***********************************!
+
+
+                   ! If there is a bond order factor associated with the potential,
+                   ! we add the contribution is brings:
+                   !
+                   ! V = \sum_ijk b_ijk v_ijk
+                   ! b_ijk = (b_i + b_j + b_k) / 3
+                   if(interaction%pot_index > -1)then
+                      ! get b_i (for all i, they have been precalculated)
+                      call core_get_bond_order_factors(interaction%pot_index,&
+                           bo_factors)
+                   else
+                      bo_factors = 1.d0
+                   end if
+
+                   ! If a smooth cutoff is present, we add the
+                   ! contribution it brings:
+                   ! 
+                   ! V = \sum_ijk v_ijk f(r_ij) f(r_ik)
+                   if(interaction%smoothened)then
+                      ! get f(r_ij)
+                      call smoothening_factor(distances(1),&
+                           interaction%cutoff,interaction%soft_cutoff,&
+                           cut_factors(1))
+                      ! get f(r_ik)
+                      call smoothening_factor(distances(2),&
+                           interaction%cutoff,interaction%soft_cutoff,&
+                           cut_factors(2))
+                   else
+                      cut_factors(1:2) = 1.d0
+                   end if
+
+                   ! evaluate the 3-body energy involving atom2-atom1-atom3 interaction
+                   call evaluate_energy(3,interaction%n_product,separations(1:3,1:2),distances(1:2),&
+                        interaction,tmp_energy,atom_triplet)
+
+                   ! add the term: b_ijk v_ijk f(r_ij) f(r_ik)
+                   energy = energy + tmp_energy*cut_factors(1)*cut_factors(2)*&
+                        (bo_factors(index1)+bo_factors(index2)+bo_factors(index3))/3.d0
+
+                case(force_evaluation_index)
+
+                   !**************!
+                   ! 3-body force !
+                   !**************!
+
+
+                   ! We will need the energy contribution 
+                   ! if smooth cutoffs or bond factors are used,
+                   ! since we are mulplying the potential.
+                   if((interaction%pot_index > -1) .or. &
+                        interaction%smoothened)then
+                      call evaluate_energy(3,interaction%n_product,separations(1:3,1:2),distances(1:2),&
+                           interaction,tmp_energy,atom_triplet) ! in Potentials.f90
+                   else
+                      tmp_energy = 0.d0
+                   end if
+
+                   ! If a smooth cutoff is present, we add the
+                   ! contribution it brings:
+                   ! 
+                   ! V = \sum_ijk v_ijk f(r_ij) f(r_ik)
+                   ! F_a = - \nabla_a V 
+                   !     = - \sum_ij ( v_ij f'(r_ij) f(r_ik) (\nabla_a r_ij) + 
+                   !                   v_ij f(r_ij) f'(r_ik) (\nabla_a r_ik) +
+                   !                   (\nabla_a v_ij) f(r_ij) f(r_ik) )
+                   !
+                   if(interaction%smoothened)then
+                      ! get f(r_ij)
+                      call smoothening_factor(distances(1),&
+                           interaction%cutoff,interaction%soft_cutoff,&
+                           cut_factors(1)) ! in Potentials.f90
+                      ! get f'(r_ij) (\nabla_a r_ij)
+                      call smoothening_gradient(directions(1:3,1),distances(1),&
+                           interaction%cutoff,interaction%soft_cutoff,&
+                           cut_gradients(1:3,1)) ! in Potentials.f90 
+                      ! get f(r_jk)
+                      call smoothening_factor(distances(2),&
+                           interaction%cutoff,interaction%soft_cutoff,&
+                           cut_factors(2)) ! in Potentials.f90
+                      ! get f'(r_jk) (\nabla_a r_jk)
+                      call smoothening_gradient(directions(1:3,2),distances(2),&
+                           interaction%cutoff,interaction%soft_cutoff,&
+                           cut_gradients(1:3,2)) ! in Potentials.f90
+                   else
+                      cut_factors(1:2) = 1.d0
+                      cut_gradients(1:3,1:2) = 0.d0
+                   end if
+
+                   ! If there is a bond order factor associated with the potential,
+                   ! we add the contribution is brings:
+                   !
+                   ! V = \sum_ijk b_ijk v_ijk
+                   ! b_ijk = (b_i + b_j + b_k) / 3
+                   ! F_a = - \nabla_a V 
+                   !     = - \sum_ijk (\nabla_a b_ijk) v_ijk + b_ijk (\nabla_a v_ijk)
+                   !     = - \sum_ijk (\nabla_a b_ijk) v_ijk + b_ij f_a,ijk
+                   !
+                   if(interaction%pot_index > -1)then
+                      ! get b_i (for all i, they have been precalculated)
+                      call core_get_bond_order_factors(interaction%pot_index,&
+                           bo_factors)
+                      ! get (\nabla_a b_i) (for all a)
+                      call core_get_bond_order_gradients(interaction%pot_index,&
+                           index1,& ! atom index
+                           1, & ! slot_index
+                           bo_gradients(1:3,1:n_atoms,1), &
+                           bo_virial(1:6,1))
+                      ! get (\nabla_a b_j) (for all a)
+                      call core_get_bond_order_gradients(interaction%pot_index,&
+                           index2,& ! atom index
+                           2, & ! slot_index
+                           bo_gradients(1:3,1:n_atoms,2), &
+                           bo_virial(1:6,2))
+                      ! get (\nabla_a b_k) (for all a)
+                      call core_get_bond_order_gradients(interaction%pot_index,&
+                           index3,& ! atom index
+                           3, & ! slot_index
+                           bo_gradients(1:3,1:n_atoms,3), &
+                           bo_virial(1:6,3))
+
+                      ! Add the bond order gradient terms involving the 
+                      ! atom2-atom1-atom3 energy for all atoms.
+                      ! That is, add the (\nabla_a b_ijk) v_ijk term with 
+                      ! the given ijk (atom2,atom1,atom3) for all a.
+                      forces(1:3,1:n_atoms) = forces(1:3,1:n_atoms) &
+                           - tmp_energy*cut_factors(1)*cut_factors(2)*&
+                           ( bo_gradients(1:3,1:n_atoms,1) &
+                           + bo_gradients(1:3,1:n_atoms,2) &
+                           + bo_gradients(1:3,1:n_atoms,3) )/3.d0
+
+                      stress(1:6) = stress(1:6) - tmp_energy*cut_factors(1)*cut_factors(2)*&
+                           ( bo_virial(1:6,1) &
+                           + bo_virial(1:6,2) &
+                           + bo_virial(1:6,3) )/3.d0
+
+                   else
+                      !bo_factors = 1.d0
+                      !bo_sums = 0.d0
+                      !bo_gradients = 0.d0
+                   end if
+
+                   ! evaluate the 3-body force
+                   call evaluate_forces(3,interaction%n_product,separations(1:3,1:2),distances(1:2),interaction,&
+                        tmp_forces(1:3,1:3),atom_triplet) ! in Potentials.f90
+
+
+                   if(interaction%pot_index > -1)then
+                    ! force on atom 1:
+                    triplet_forces(1:3,1) = ( tmp_forces(1:3,1)*cut_factors(1)*cut_factors(2) + &
+                        cut_gradients(1:3,1)*cut_factors(2)*tmp_energy ) * &
+                        ( bo_factors(index1) &
+                        + bo_factors(index2) &
+                        + bo_factors(index3) )/3.d0
+
+                    ! force on atom 2:
+                    triplet_forces(1:3,2) = ( tmp_forces(1:3,2)*cut_factors(1)*cut_factors(2) + &
+                        (-cut_gradients(1:3,1)*cut_factors(2) + &
+                        cut_gradients(1:3,2)*cut_factors(1)) * tmp_energy ) * &
+                        ( bo_factors(index1) &
+                        + bo_factors(index2) &
+                        + bo_factors(index3) )/3.d0
+
+                    ! force on atom 3:
+                    triplet_forces(1:3,3) = ( tmp_forces(1:3,3)*cut_factors(1)*cut_factors(2) - &
+                        cut_gradients(1:3,2)*cut_factors(1)*tmp_energy ) * &
+                        ( bo_factors(index1) &
+                        + bo_factors(index2) &
+                        + bo_factors(index3) )/3.d0
+                   else
+                    ! force on atom 1:
+                    triplet_forces(1:3,1) = ( tmp_forces(1:3,1)*cut_factors(1)*cut_factors(2) + &
+                        cut_gradients(1:3,1)*cut_factors(2)*tmp_energy ) 
+
+                    ! force on atom 2:
+                    triplet_forces(1:3,2) = ( tmp_forces(1:3,2)*cut_factors(1)*cut_factors(2) + &
+                        (-cut_gradients(1:3,1)*cut_factors(2) + &
+                        cut_gradients(1:3,2)*cut_factors(1)) * tmp_energy ) 
+
+                    ! force on atom 3:
+                    triplet_forces(1:3,3) = ( tmp_forces(1:3,3)*cut_factors(1)*cut_factors(2) - &
+                        cut_gradients(1:3,2)*cut_factors(1)*tmp_energy ) 
+                   
+                   end if
+
+                   forces(1:3,index1) = forces(1:3,index1) + triplet_forces(1:3,1)
+                   forces(1:3,index2) = forces(1:3,index2) + triplet_forces(1:3,2)
+                   forces(1:3,index3) = forces(1:3,index3) + triplet_forces(1:3,3)
+                        
+                   !***************!
+                   ! stress tensor !
+                   !***************!
+                   
+                   ! s_xx, s_yy, s_zz, s_yz, s_xz, s_xy:
+                   stress(1) = stress(1) + separations(1,1) * triplet_forces(1,2) &
+                        + (separations(1,1) + separations(1,2)) * triplet_forces(1,3)
+                   stress(2) = stress(2) + separations(2,1) * triplet_forces(2,2) &
+                        + (separations(2,1) + separations(2,2)) * triplet_forces(2,3)
+                   stress(3) = stress(3) + separations(3,1) * triplet_forces(3,2) &
+                        + (separations(3,1) + separations(3,2)) * triplet_forces(3,3)
+                   stress(4) = stress(4) + separations(2,1) * triplet_forces(3,2) &
+                        + (separations(2,1) + separations(2,2)) * triplet_forces(3,3)
+                   stress(5) = stress(5) + separations(1,1) * triplet_forces(3,2) &
+                        + (separations(1,1) + separations(1,2)) * triplet_forces(3,3)
+                   stress(6) = stress(6) + separations(1,1) * triplet_forces(2,2) &
+                        + (separations(1,1) + separations(1,2)) * triplet_forces(2,3)
+
+                case(electronegativity_evaluation_index)
+
+                   !**********************************************!
+                   ! 3-body electronegativity (atom1-atom2-atom3) !
+                   !**********************************************!
+
+                   ! If a smooth cutoff is present, we add the
+                   ! contribution it brings:
+                   if(interaction%smoothened)then
+                      ! get f(r_ij)
+                      call smoothening_factor(distances(1),&
+                           interaction%cutoff,interaction%soft_cutoff,&
+                           cut_factors(1)) ! in Potentials.f90
+                      ! get f(r_ik)
+                      call smoothening_factor(distances(2),&
+                           interaction%cutoff,interaction%soft_cutoff,&
+                           cut_factors(2)) ! in Potentials.f90
+                   else
+                      cut_factors(1:2) = 1.d0
+                   end if
+
+                   ! If there is a bond order factor associated with the potential,
+                   ! we add the contribution is brings:
+                   if(interaction%pot_index > -1)then
+                      ! get b_i (for all i, they have been precalculated)
+                      call core_get_bond_order_factors(interaction%pot_index,&
+                           bo_factors) ! in Potentials.f90
+                   else
+                      bo_factors = 1.d0
+                   end if
+
+                   ! evaluate the 3-body e-neg involving atom2-atom1-atom3 interaction
+                   call evaluate_electronegativity(3,interaction%n_product,separations(1:3,1:2),&
+                        distances(1:2),interaction,&
+                        tmp_enegs(1:3),atom_triplet) ! in Potentials.f90
+
+                   ! e-neg on atom 1:
+                   enegs(index1) = enegs(index1) + &
+                        ( tmp_enegs(1)*cut_factors(1)*cut_factors(2) ) * &
+                        ( bo_factors(index1) &
+                        + bo_factors(index2) &
+                        + bo_factors(index3) )/3.d0
+
+                   ! e-neg on atom 2:
+                   enegs(index2) = enegs(index2) + &
+                        ( tmp_enegs(2)*cut_factors(1)*cut_factors(2) ) * &
+                        ( bo_factors(index1) &
+                        + bo_factors(index2) &
+                        + bo_factors(index3) )/3.d0
+
+                   ! e-neg on atom 3:
+                   enegs(index3) = enegs(index3) + &
+                        ( tmp_enegs(3)*cut_factors(1)*cut_factors(2) ) * &
+                        ( bo_factors(index1) &
+                        + bo_factors(index2) &
+                        + bo_factors(index3) )/3.d0
+
+
+                end select
+
+
+             end if ! interaction%cutoff > distances(2)
+
+          end if ! is_active
+       else if(n_targets > 3)then
+
+          many_bodies_found = .true.
+
+       end if ! is_active .and. n_targets == 3
+
+    end do ! k = 1, size(interaction_indices)
+
+
+  end subroutine core_evaluate_local_triplet
+
+
+
+
+
+  ! Evaluates the interactions affecting three atoms. (Rearranged internally.)
+  !
+  ! *n_atoms total number of atoms in the system
+  ! *index1 index of the atom 1
+  ! *index2 index of the atom 2
+  ! *index3 index of the atom 3
+  ! *atom_triplet the atoms that are targeted
+  ! *test_index1 if 1, test if the ineraction targets atom1; similarly for 2, 3
+  ! *test_index2 if 1, test if the ineraction targets atom1; similarly for 2, 3
+  ! *interaction_indices the interactions targeting the given atoms
+  ! *separations distance vector from 1 to 2 and 2 to 3 as an array
+  ! *directions unit vector from 1 to 2 and 2 to 3 as an array
+  ! *distances distance from 1 to 2 and 2 to 3 as an array
+  ! *calculation_type the type of information requested
+  ! *energy calculated energy
+  ! *forces calculated forces
+  ! *stress calculated stress
+  ! *enegs calculated electronegativities
+  ! *many_bodies_found returns true if the loop finds an interaction with 3 or more targets
+  ! *skip_triplets optional logical tag; if true, the 3-body interactions are not evaluated and only the 4-body interactions are searched for
+  subroutine core_evaluate_local_triplet_B(atom_triplet, &
+       index1, index2, index3, &
+       test_index1, test_index2, &
+       !interaction_indices, &
+       separations, directions, distances, &
+       calculation_type,energy,forces,enegs,stress, &
+       many_bodies_found, &
+       manybody_indices, &
+       n_manybody, &
+       skip_triplets)
+    implicit none
+    integer, intent(in) :: calculation_type, index1, index2, index3, &
+         test_index1, test_index2, n_manybody
+    !integer, pointer :: interaction_indices(:), manybody_indices(:)
+    integer, pointer :: manybody_indices(:)
+    double precision, intent(inout) :: energy, forces(:,:), enegs(:), stress(6)
+    double precision, intent(in) :: separations(3,2), directions(3,2), distances(2)
+    logical, intent(out) :: many_bodies_found
+    type(atom), intent(in) :: atom_triplet(3)
+    logical, optional, intent(in) :: skip_triplets
+
+    type(atom) :: atom1, atom2, atom3
+    integer :: k, n_targets, n_atoms
+    type(potential) :: interaction
+    double precision :: tmp_energy, tmp_forces(3,3), tmp_enegs(3), &
+         cut_factors(2), cut_gradients(3,2), &
+         triplet_forces(3,3), bo_virial(6,3), prefactor
+    logical :: is_active, evaluate_triplets
+
+    evaluate_triplets = .true.
+    if(present(skip_triplets))then
+       evaluate_triplets = .not.skip_triplets
+    end if
+    many_bodies_found = .false.
+    atom1 = atom_triplet(1)
+    atom2 = atom_triplet(2)
+    atom3 = atom_triplet(3)
+
+    ! loop over the potentials affecting atom1
+    do k = 1, n_manybody !size(interaction_indices)
+
+       interaction = interactions(manybody_indices(k))
+       call get_number_of_targets_of_potential_index(interaction%type_index,&
+            n_targets) ! in Potentials.f90
+       if( n_targets == 3 .and. .not.evaluate_triplets )then
+          ! only the 4-body interactions are needed
+          cycle
+       end if
+       call potential_affects_atom(interaction,atom_triplet(test_index1),is_active,2) ! in Potentials.f90
+
+       ! filter the potentials by:
+       ! is atom2 affected by the potential,
+       ! is atom3 affected by the potential,
+       ! is it a 3-body potential
+       if( is_active .and. n_targets == 3 .and. interaction%cutoff > distances(1) )then
+          call potential_affects_atom(interaction,atom_triplet(test_index2),is_active,3)  ! in Potentials.f90
+          if( is_active )then
+
+             if( interaction%cutoff > distances(2) )then
+
+
+                ! differentiate between energy, force, and electronegativity evaluation
+                select case(calculation_type)
+                case(energy_evaluation_index)
+
+                   !***********************************!
+                   ! 3-body energy (atom1-atom2-atom3) !
+                   !***********************************!
+
+
+                   ! If there is a bond order factor associated with the potential,
+                   ! we add the contribution is brings:
+                   !
+                   ! V = \sum_ijk b_ijk v_ijk
+                   ! b_ijk = (b_i + b_j + b_k) / 3
+                   if(interaction%pot_index > -1)then
+                      ! get b_i (they have been precalculated)
+                      call core_get_bond_order_factor_of_atom(interaction%pot_index,&
+                           index1,bo_factors(index1))
+                      call core_get_bond_order_factor_of_atom(interaction%pot_index,&
+                           index2,bo_factors(index2))
+                      call core_get_bond_order_factor_of_atom(interaction%pot_index,&
+                           index3,bo_factors(index3))
+                   else
+
+                   end if
+
+                   ! If a smooth cutoff is present, we add the
+                   ! contribution it brings:
+                   ! 
+                   ! V = \sum_ijk v_ijk f(r_ij) f(r_ik)
+                   if(interaction%smoothened)then
+                      ! get f(r_ij)
+                      call smoothening_factor(distances(1),&
+                           interaction%cutoff,interaction%soft_cutoff,&
+                           cut_factors(1))
+                      ! get f(r_ik)
+                      call smoothening_factor(distances(2),&
+                           interaction%cutoff,interaction%soft_cutoff,&
+                           cut_factors(2))
+                   else
+                      cut_factors(1:2) = 1.d0
+                   end if
+
+                   ! evaluate the 3-body energy involving atom2-atom1-atom3 interaction
+                   call evaluate_energy(3,interaction%n_product,separations(1:3,1:2),distances(1:2),&
+                        interaction,tmp_energy,atom_triplet)
+
+                   if(interaction%pot_index > -1)then
+                      ! add the term: b_ijk v_ijk f(r_ij) f(r_ik)
+                      energy = energy + tmp_energy*cut_factors(1)*cut_factors(2)*&
+                           (bo_factors(index1)+bo_factors(index2)+bo_factors(index3))/3.d0
+                   else
+                      energy = energy + tmp_energy*cut_factors(1)*cut_factors(2)
+                   end if
+
+                case(force_evaluation_index)
+
+                   !**************!
+                   ! 3-body force !
+                   !**************!
+
+
+                   ! We will need the energy contribution 
+                   ! if smooth cutoffs or bond factors are used,
+                   ! since we are mulplying the potential.
+                   if((interaction%pot_index > -1) .or. &
+                        interaction%smoothened)then
+                      call evaluate_energy(3,interaction%n_product,separations(1:3,1:2),distances(1:2),&
+                           interaction,tmp_energy,atom_triplet) ! in Potentials.f90
+                   else
+                      tmp_energy = 0.d0
+                   end if
+
+                   ! If a smooth cutoff is present, we add the
+                   ! contribution it brings:
+                   ! 
+                   ! V = \sum_ijk v_ijk f(r_ij) f(r_ik)
+                   ! F_a = - \nabla_a V 
+                   !     = - \sum_ij ( v_ij f'(r_ij) f(r_ik) (\nabla_a r_ij) + 
+                   !                   v_ij f(r_ij) f'(r_ik) (\nabla_a r_ik) +
+                   !                   (\nabla_a v_ij) f(r_ij) f(r_ik) )
+                   !
+                   if(interaction%smoothened)then
+                      ! get f(r_ij)
+                      call smoothening_factor(distances(1),&
+                           interaction%cutoff,interaction%soft_cutoff,&
+                           cut_factors(1)) ! in Potentials.f90
+                      ! get f'(r_ij) (\nabla_a r_ij)
+                      call smoothening_gradient(directions(1:3,1),distances(1),&
+                           interaction%cutoff,interaction%soft_cutoff,&
+                           cut_gradients(1:3,1)) ! in Potentials.f90 
+                      ! get f(r_jk)
+                      call smoothening_factor(distances(2),&
+                           interaction%cutoff,interaction%soft_cutoff,&
+                           cut_factors(2)) ! in Potentials.f90
+                      ! get f'(r_jk) (\nabla_a r_jk)
+                      call smoothening_gradient(directions(1:3,2),distances(2),&
+                           interaction%cutoff,interaction%soft_cutoff,&
+                           cut_gradients(1:3,2)) ! in Potentials.f90
+                   else
+                      cut_factors(1:2) = 1.d0
+                      cut_gradients(1:3,1:2) = 0.d0
+                   end if
+
+                   ! If there is a bond order factor associated with the potential,
+                   ! we add the contribution is brings:
+                   !
+                   ! V = \sum_ijk b_ijk v_ijk
+                   ! b_ijk = (b_i + b_j + b_k) / 3
+                   ! F_a = - \nabla_a V 
+                   !     = - \sum_ijk (\nabla_a b_ijk) v_ijk + b_ijk (\nabla_a v_ijk)
+                   !     = - \sum_ijk (\nabla_a b_ijk) v_ijk + b_ij f_a,ijk
+                   !
+                   if(interaction%pot_index > -1)then
+                      ! get b_i (for all i, they have been precalculated)
+                      call core_get_bond_order_factors(interaction%pot_index,&
+                           bo_factors)
+                      
+                      prefactor = tmp_energy*cut_factors(1)*cut_factors(2)/3.d0
+
+                      call core_add_bond_order_forces( &
+                           interaction%pot_index, index1, prefactor, &
+                           forces, stress )
+
+                      call core_add_bond_order_forces( &
+                           interaction%pot_index, index2, prefactor, &
+                           forces, stress )
+
+                      call core_add_bond_order_forces( &
+                           interaction%pot_index, index3, prefactor, &
+                           forces, stress )
+
+!!$                      ! get (\nabla_a b_i) (for all a)
+!!$                      call core_get_bond_order_gradients(interaction%pot_index,&
+!!$                           index1,& ! atom index
+!!$                           1, & ! slot_index
+!!$                           bo_gradients(1:3,1:n_atoms,1), &
+!!$                           bo_virial(1:6,1))
+!!$                      ! get (\nabla_a b_j) (for all a)
+!!$                      call core_get_bond_order_gradients(interaction%pot_index,&
+!!$                           index2,& ! atom index
+!!$                           2, & ! slot_index
+!!$                           bo_gradients(1:3,1:n_atoms,2), &
+!!$                           bo_virial(1:6,2))
+!!$                      ! get (\nabla_a b_k) (for all a)
+!!$                      call core_get_bond_order_gradients(interaction%pot_index,&
+!!$                           index3,& ! atom index
+!!$                           3, & ! slot_index
+!!$                           bo_gradients(1:3,1:n_atoms,3), &
+!!$                           bo_virial(1:6,3))
+!!$
+!!$
+!!$                      ! Add the bond order gradient terms involving the 
+!!$                      ! atom2-atom1-atom3 energy for all atoms.
+!!$                      ! That is, add the (\nabla_a b_ijk) v_ijk term with 
+!!$                      ! the given ijk (atom2,atom1,atom3) for all a.
+!!$                      forces(1:3,1:n_atoms) = forces(1:3,1:n_atoms) &
+!!$                           - tmp_energy*cut_factors(1)*cut_factors(2)*&
+!!$                           ( bo_gradients(1:3,1:n_atoms,1) &
+!!$                           + bo_gradients(1:3,1:n_atoms,2) &
+!!$                           + bo_gradients(1:3,1:n_atoms,3) )/3.d0
+!!$
+!!$                      stress(1:6) = stress(1:6) - tmp_energy*cut_factors(1)*cut_factors(2)*&
+!!$                           ( bo_virial(1:6,1) &
+!!$                           + bo_virial(1:6,2) &
+!!$                           + bo_virial(1:6,3) )/3.d0
+
+                   else
+                      !bo_factors = 1.d0
+                      !bo_sums = 0.d0
+                      !bo_gradients = 0.d0
+                   end if
+
+                   ! evaluate the 3-body force
+                   call evaluate_forces(3,interaction%n_product,separations(1:3,1:2),distances(1:2),interaction,&
+                        tmp_forces(1:3,1:3),atom_triplet) ! in Potentials.f90
+
+                   if(interaction%pot_index > -1)then
+                      ! force on atom 1:
+                      triplet_forces(1:3,1) = ( tmp_forces(1:3,1)*cut_factors(1)*cut_factors(2) + &
+                           cut_gradients(1:3,1)*cut_factors(2)*tmp_energy ) * &
+                           ( bo_factors(index1) &
+                           + bo_factors(index2) &
+                           + bo_factors(index3) )/3.d0
+                      
+                      ! force on atom 2:
+                      triplet_forces(1:3,2) = ( tmp_forces(1:3,2)*cut_factors(1)*cut_factors(2) + &
+                           (-cut_gradients(1:3,1)*cut_factors(2) + &
+                           cut_gradients(1:3,2)*cut_factors(1)) * tmp_energy ) * &
+                           ( bo_factors(index1) &
+                           + bo_factors(index2) &
+                           + bo_factors(index3) )/3.d0
+                      
+                      ! force on atom 3:
+                      triplet_forces(1:3,3) = ( tmp_forces(1:3,3)*cut_factors(1)*cut_factors(2) - &
+                           cut_gradients(1:3,2)*cut_factors(1)*tmp_energy ) * &
+                           ( bo_factors(index1) &
+                           + bo_factors(index2) &
+                           + bo_factors(index3) )/3.d0
+                   else
+                      ! force on atom 1:
+                      triplet_forces(1:3,1) = ( tmp_forces(1:3,1)*cut_factors(1)*cut_factors(2) + &
+                           cut_gradients(1:3,1)*cut_factors(2)*tmp_energy ) 
+                      
+                      ! force on atom 2:
+                      triplet_forces(1:3,2) = ( tmp_forces(1:3,2)*cut_factors(1)*cut_factors(2) + &
+                           (-cut_gradients(1:3,1)*cut_factors(2) + &
+                           cut_gradients(1:3,2)*cut_factors(1)) * tmp_energy ) 
+                      
+                      ! force on atom 3:
+                      triplet_forces(1:3,3) = ( tmp_forces(1:3,3)*cut_factors(1)*cut_factors(2) - &
+                           cut_gradients(1:3,2)*cut_factors(1)*tmp_energy ) 
+                      
+                   end if
+
+                   forces(1:3,index1) = forces(1:3,index1) + triplet_forces(1:3,1)
+                   forces(1:3,index2) = forces(1:3,index2) + triplet_forces(1:3,2)
+                   forces(1:3,index3) = forces(1:3,index3) + triplet_forces(1:3,3)
+                        
+                   !***************!
+                   ! stress tensor !
+                   !***************!
+                   
+                   ! s_xx, s_yy, s_zz, s_yz, s_xz, s_xy:
+                   stress(1) = stress(1) + separations(1,1) * triplet_forces(1,2) &
+                        + (separations(1,1) + separations(1,2)) * triplet_forces(1,3)
+                   stress(2) = stress(2) + separations(2,1) * triplet_forces(2,2) &
+                        + (separations(2,1) + separations(2,2)) * triplet_forces(2,3)
+                   stress(3) = stress(3) + separations(3,1) * triplet_forces(3,2) &
+                        + (separations(3,1) + separations(3,2)) * triplet_forces(3,3)
+                   stress(4) = stress(4) + separations(2,1) * triplet_forces(3,2) &
+                        + (separations(2,1) + separations(2,2)) * triplet_forces(3,3)
+                   stress(5) = stress(5) + separations(1,1) * triplet_forces(3,2) &
+                        + (separations(1,1) + separations(1,2)) * triplet_forces(3,3)
+                   stress(6) = stress(6) + separations(1,1) * triplet_forces(2,2) &
+                        + (separations(1,1) + separations(1,2)) * triplet_forces(2,3)
+
+                case(electronegativity_evaluation_index)
+
+                   !**********************************************!
+                   ! 3-body electronegativity (atom1-atom2-atom3) !
+                   !**********************************************!
+
+                   ! If a smooth cutoff is present, we add the
+                   ! contribution it brings:
+                   if(interaction%smoothened)then
+                      ! get f(r_ij)
+                      call smoothening_factor(distances(1),&
+                           interaction%cutoff,interaction%soft_cutoff,&
+                           cut_factors(1)) ! in Potentials.f90
+                      ! get f(r_ik)
+                      call smoothening_factor(distances(2),&
+                           interaction%cutoff,interaction%soft_cutoff,&
+                           cut_factors(2)) ! in Potentials.f90
+                   else
+                      cut_factors(1:2) = 1.d0
+                   end if
+
+                   ! If there is a bond order factor associated with the potential,
+                   ! we add the contribution is brings:
+                   if(interaction%pot_index > -1)then
+                      ! get b_i (for all i, they have been precalculated)
+                      call core_get_bond_order_factors(interaction%pot_index,&
+                           bo_factors) ! in Potentials.f90
+                   else
+                      !bo_factors = 1.d0
+                   end if
+
+                   ! evaluate the 3-body e-neg involving atom2-atom1-atom3 interaction
+                   call evaluate_electronegativity(3,interaction%n_product,separations(1:3,1:2),&
+                        distances(1:2),interaction,&
+                        tmp_enegs(1:3),atom_triplet) ! in Potentials.f90
+
+                   if(interaction%pot_index > -1)then
+                      ! e-neg on atom 1:
+                      enegs(index1) = enegs(index1) + &
+                           ( tmp_enegs(1)*cut_factors(1)*cut_factors(2) ) * &
+                           ( bo_factors(index1) &
+                           + bo_factors(index2) &
+                           + bo_factors(index3) )/3.d0
+                      
+                      ! e-neg on atom 2:
+                      enegs(index2) = enegs(index2) + &
+                           ( tmp_enegs(2)*cut_factors(1)*cut_factors(2) ) * &
+                           ( bo_factors(index1) &
+                           + bo_factors(index2) &
+                           + bo_factors(index3) )/3.d0
+                      
+                      ! e-neg on atom 3:
+                      enegs(index3) = enegs(index3) + &
+                           ( tmp_enegs(3)*cut_factors(1)*cut_factors(2) ) * &
+                           ( bo_factors(index1) &
+                           + bo_factors(index2) &
+                           + bo_factors(index3) )/3.d0
+
+                   else
+                      ! e-neg on atom 1:
+                      enegs(index1) = enegs(index1) + &
+                           ( tmp_enegs(1)*cut_factors(1)*cut_factors(2) ) 
+                      
+                      ! e-neg on atom 2:
+                      enegs(index2) = enegs(index2) + &
+                           ( tmp_enegs(2)*cut_factors(1)*cut_factors(2) ) 
+                      
+                      ! e-neg on atom 3:
+                      enegs(index3) = enegs(index3) + &
+                           ( tmp_enegs(3)*cut_factors(1)*cut_factors(2) ) 
+
+                   end if
+
+                end select
+
+
+             end if ! interaction%cutoff > distances(2)
+
+          end if ! is_active
+       else if(n_targets > 3)then
+
+          many_bodies_found = .true.
+
+       end if ! is_active .and. n_targets == 3
+
+    end do ! k = 1, size(interaction_indices)
+
+
+  end subroutine core_evaluate_local_triplet_B
+
+
+
+
+
+
+
+  ! Evaluates the interactions affecting four atoms.
+  !
+  ! *n_atoms total number of atoms in the system
+  ! *index1 index of the atom 1
+  ! *index2 index of the atom 2
+  ! *index3 index of the atom 3
+  ! *index4 index of the atom 4
+  ! *atom_quadruplet the atoms that are targeted
+  ! *test_index1 if 1, test if the ineraction targets atom1; similarly for 2, 3
+  ! *test_index2 if 1, test if the ineraction targets atom1; similarly for 2, 3
+  ! *test_index3 if 1, test if the ineraction targets atom1; similarly for 2, 3
+  ! *interaction_indices the interactions targeting the given atoms
+  ! *separations distance vector from 1 to 2, 2 to 3 and 3 to 4 as an array
+  ! *directions unit vector from 1 to 2, 2 to 3 and 3 to 4 as an array
+  ! *distances distance from 1 to 2, 2 to 3 and 3 to 4 as an array
+  ! *calculation_type the type of information requested
+  ! *energy calculated energy
+  ! *forces calculated forces
+  ! *stress calculated stress
+  ! *enegs calculated electronegativities
+  ! *many_bodies_found returns true if the loop finds an interaction with 3 or more targets
+  subroutine core_evaluate_local_quadruplet(n_atoms, &
+       atom_quadruplet, &
+       index1, index2, index3, index4, &
+       test_index1, test_index2, test_index3, &
+       interaction_indices, &
+       separations, directions, distances, &
+       calculation_type,energy,forces,enegs,stress, &
+       many_bodies_found)
+    implicit none
+    integer, intent(in) :: calculation_type, n_atoms, index1, index2, index3, index4, &
+         test_index1, test_index2, test_index3
+    integer, pointer :: interaction_indices(:)
+    double precision, intent(out) :: energy, forces(3,n_atoms), enegs(n_atoms), stress(6)
+    double precision, intent(in) :: separations(3,3), directions(3,3), distances(3)
+    logical, intent(out) :: many_bodies_found
+    type(atom), intent(in) :: atom_quadruplet(4)
+
+    type(atom) :: atom1, atom2, atom3, atom4
+    integer :: k, n_targets
+    type(potential) :: interaction
+    double precision :: bo_factors(n_atoms), bo_sums(n_atoms), bo_gradients(3,n_atoms,4), &
+         tmp_energy, tmp_forces(3,4), tmp_enegs(4), &
+         cut_factors(3), cut_gradients(3,3), quad_forces(3,4), bo_virial(6,4)
+    logical :: is_active
+
+
+    many_bodies_found = .false.
+    atom1 = atom_quadruplet(1)
+    atom2 = atom_quadruplet(2)
+    atom3 = atom_quadruplet(3)
+    atom4 = atom_quadruplet(3)
+
+    ! loop over the potentials affecting atom1
+    do k = 1, size(interaction_indices)
+
+       interaction = interactions(interaction_indices(k))
+       call get_number_of_targets_of_potential_index(interaction%type_index,&
+            n_targets) ! in Potentials.f90
+       call potential_affects_atom(interaction,atom_quadruplet(test_index1),is_active,2) ! in Potentials.f90
+
+       ! filter the potentials by:
+       ! is atom2 affected by the potential,
+       ! is atom3 affected by the potential,
+       ! is atom4 affected by the potential,
+       ! is it a 4-body potential
+       if( is_active .and. n_targets == 4 .and. interaction%cutoff > distances(1) )then
+          call potential_affects_atom(interaction,atom_quadruplet(test_index2),is_active,3)  ! in Potentials.f90
+          if( is_active )then
+             call potential_affects_atom(interaction,atom_quadruplet(test_index3),is_active,4)  ! in Potentials.f90
+             if( is_active )then
+                if( interaction%cutoff > distances(2) .and. interaction%cutoff > distances(3) )then
+
+                   ! differentiate between energy, force, and electronegativity evaluation
+                   select case(calculation_type)
+                   case(energy_evaluation_index)
+
+                      !***************!
+                      ! 4-body energy !
+                      !***************!
+
+                      ! If there is a bond order factor associated with the potential,
+                      ! we add the contribution is brings:
+                      !
+                      ! V = \sum_ijkl b_ijkl v_ijkl
+                      ! b_ijkl = (b_i + b_j + b_k + b_l) / 4
+                      if(interaction%pot_index > -1)then
+                         ! get b_i (for all i, they have been precalculated)
+                         call core_get_bond_order_factors(interaction%pot_index,&
+                              bo_factors)
+                      else
+                         bo_factors = 1.d0
+                      end if
+
+                      ! If a smooth cutoff is present, we add the
+                      ! contribution it brings:
+                      ! 
+                      ! V = \sum_ijkl v_ijkl f(r_ij) f(r_jk) f(r_kl)
+                      if(interaction%smoothened)then
+                         ! get f(r_ij)
+                         call smoothening_factor(distances(1),&
+                              interaction%cutoff,interaction%soft_cutoff,&
+                              cut_factors(1))
+                         ! get f(r_jk)
+                         call smoothening_factor(distances(2),&
+                              interaction%cutoff,interaction%soft_cutoff,&
+                              cut_factors(2))
+                         ! get f(r_kl)
+                         call smoothening_factor(distances(3),&
+                              interaction%cutoff,interaction%soft_cutoff,&
+                              cut_factors(3))
+                      else
+                         cut_factors(1:3) = 1.d0
+                      end if
+
+                      ! evaluate the 4-body energy
+                      call evaluate_energy(4,interaction%n_product,separations(1:3,1:3),distances(1:3),&
+                           interaction,tmp_energy,atom_quadruplet)
+
+                      ! add the term: b_ijkl v_ijkl f(r_ij) f(r_jk) f(r_lk)
+                      energy = energy + tmp_energy*cut_factors(1)*cut_factors(2)*cut_factors(3)*&
+                           (bo_factors(index1)+bo_factors(index2)+bo_factors(index3)+bo_factors(index3))/4.d0
+
+                   case(force_evaluation_index)
+
+                      !**************!
+                      ! 4-body force !
+                      !**************!
+
+                      ! We will need the energy contribution 
+                      ! if smooth cutoffs or bond factors are used,
+                      ! since we are mulplying the potential.
+                      if((interaction%pot_index > -1) .or. &
+                           interaction%smoothened)then
+                         call evaluate_energy(4,interaction%n_product,separations(1:3,1:3),distances(1:3),&
+                              interaction,tmp_energy,atom_quadruplet) ! in Potentials.f90
+                      else
+                         tmp_energy = 0.d0
+                      end if
+
+                      ! If a smooth cutoff is present, we add the
+                      ! contribution it brings:
+                      ! 
+                      ! V = \sum_ijkl v_ijkl f(r_ij) f(r_jk) f(r_kl)
+                      ! F_a = - \nabla_a V 
+                      !     = - \sum_ijkl ( v_ijkl f'(r_ij) f(r_jk) f(r_kl) (\nabla_a r_ij) + 
+                      !                   v_ijkl f(r_ij) f'(r_jk) f(r_kl) (\nabla_a r_jk) + 
+                      !                   v_ijkl f(r_ij) f(r_jk) f'(r_kl) (\nabla_a r_kl) +
+                      !                   (\nabla_a v_ijkl) f(r_ij) f(r_jk) f(r_kl) )
+                      !
+                      if(interaction%smoothened)then
+                         ! get f(r_ij)
+                         call smoothening_factor(distances(1),&
+                              interaction%cutoff,interaction%soft_cutoff,&
+                              cut_factors(1)) ! in Potentials.f90
+                         ! get f'(r_ij) (\nabla_a r_ij)
+                         call smoothening_gradient(directions(1:3,1),distances(1),&
+                              interaction%cutoff,interaction%soft_cutoff,&
+                              cut_gradients(1:3,1)) ! in Potentials.f90 
+                         ! get f(r_jk)
+                         call smoothening_factor(distances(2),&
+                              interaction%cutoff,interaction%soft_cutoff,&
+                              cut_factors(2)) ! in Potentials.f90
+                         ! get f'(r_jk) (\nabla_a r_ik)
+                         call smoothening_gradient(directions(1:3,2),distances(2),&
+                              interaction%cutoff,interaction%soft_cutoff,&
+                              cut_gradients(1:3,2)) ! in Potentials.f90
+                         ! get f(r_kl)
+                         call smoothening_factor(distances(3),&
+                              interaction%cutoff,interaction%soft_cutoff,&
+                              cut_factors(3)) ! in Potentials.f90
+                         ! get f'(r_kl) (\nabla_a r_kl)
+                         call smoothening_gradient(directions(1:3,3),distances(3),&
+                              interaction%cutoff,interaction%soft_cutoff,&
+                              cut_gradients(1:3,3)) ! in Potentials.f90
+                      else
+                         cut_factors(1:3) = 1.d0
+                         cut_gradients(1:3,1:3) = 0.d0
+                      end if
+
+
+                      ! If there is a bond order factor associated with the potential,
+                      ! we add the contribution is brings:
+                      !
+                      ! V = \sum_ijkl b_ijkl v_ijkl
+                      ! b_ijkl = (b_i + b_j + b_k + b_l) / 4
+                      ! F_a = - \nabla_a V 
+                      !     = - \sum_ijkl (\nabla_a b_ijkl) v_ijkl + b_ijkl (\nabla_a v_ijkl)
+                      !     = - \sum_ijkl (\nabla_a b_ijkl) v_ijkl + b_ijkl f_a,ijkl
+                      !
+                      if(interaction%pot_index > -1)then
+                         ! get b_i (for all i, they have been precalculated)
+                         call core_get_bond_order_factors(interaction%pot_index,&
+                              bo_factors) ! in Potentials.f90
+                         ! get (\nabla_a b_i) (for all a)
+                         call core_get_bond_order_gradients(interaction%pot_index,&
+                              index1,& ! atom index
+                              1, & ! slot_index
+                              bo_gradients(1:3,1:n_atoms,1), &
+                              bo_virial(1:6,1)) ! in Potentials.f90
+                         ! get (\nabla_a b_j) (for all a)
+                         call core_get_bond_order_gradients(interaction%pot_index,&
+                              index2,& ! atom index
+                              2, & ! slot_index
+                              bo_gradients(1:3,1:n_atoms,2), &
+                              bo_virial(1:6,2)) ! in Potentials.f90
+                         ! get (\nabla_a b_k) (for all a)
+                         call core_get_bond_order_gradients(interaction%pot_index,&
+                              index3,& ! atom index
+                              3, & ! slot_index
+                              bo_gradients(1:3,1:n_atoms,3), &
+                              bo_virial(1:6,3)) ! in Potentials.f90
+                         ! get (\nabla_a b_l) (for all a)
+                         call core_get_bond_order_gradients(interaction%pot_index,&
+                              index4,& ! atom index
+                              4, & ! slot_index
+                              bo_gradients(1:3,1:n_atoms,4), &
+                              bo_virial(1:6,4)) ! in Potentials.f90
+
+                         ! Add the bond order gradient terms involving the 
+                         ! atom2-atom1-atom3 energy for all atoms.
+                         ! That is, add the (\nabla_a b_ijk) v_ijk term with 
+                         ! the given ijk (atom2,atom1,atom3) for all a.
+                         forces(1:3,1:n_atoms) = forces(1:3,1:n_atoms) &
+                              - tmp_energy*cut_factors(1)*cut_factors(2)*cut_factors(3)* &
+                              ( bo_gradients(1:3,1:n_atoms,1) &
+                              + bo_gradients(1:3,1:n_atoms,2) &
+                              + bo_gradients(1:3,1:n_atoms,3) &
+                              + bo_gradients(1:3,1:n_atoms,4) )/4.d0
+
+                         stress(1:6) = stress(1:6) - tmp_energy*cut_factors(1)*cut_factors(2)*cut_factors(3)* &
+                              ( bo_virial(1:6,1) &
+                              + bo_virial(1:6,2) &
+                              + bo_virial(1:6,3) &
+                              + bo_virial(1:6,4) )/4.d0
+
+                      else
+                         bo_factors = 1.d0
+                         bo_sums = 0.d0
+                         bo_gradients = 0.d0
+                      end if
+
+
+                      ! evaluate the 4-body force
+                      call evaluate_forces(4,interaction%n_product,separations(1:3,1:3),distances(1:3),interaction,&
+                           tmp_forces(1:3,1:4),atom_quadruplet) ! in Potentials.f90
+
+                      ! force on atom 1:
+                      quad_forces(1:3,1) = ( tmp_forces(1:3,1)*cut_factors(1)*cut_factors(2)*cut_factors(3) + &
+                           cut_gradients(1:3,1)*cut_factors(2)*cut_factors(3)*tmp_energy ) * &
+                           ( bo_factors(index1) &
+                           + bo_factors(index2) &
+                           + bo_factors(index3) &
+                           + bo_factors(index4) )/4.d0
+
+                      ! force on atom 2:
+                      quad_forces(1:3,2) = ( tmp_forces(1:3,2)*cut_factors(1)*cut_factors(2)*cut_factors(3) + &
+                           (-cut_gradients(1:3,1)*cut_factors(2)*cut_factors(3) + &
+                           cut_gradients(1:3,2)*cut_factors(1)*cut_factors(3)) * tmp_energy ) * &
+                           ( bo_factors(index1) &
+                           + bo_factors(index2) &
+                           + bo_factors(index3) &
+                           + bo_factors(index4) )/4.d0
+
+                      ! force on atom 3:
+                      quad_forces(1:3,3) = ( tmp_forces(1:3,3)*cut_factors(1)*cut_factors(2)*cut_factors(3) + &
+                           (cut_gradients(1:3,3)*cut_factors(1)*cut_factors(2) - &
+                           cut_gradients(1:3,2)*cut_factors(1)*cut_factors(3)) * tmp_energy ) * &
+                           ( bo_factors(index1) &
+                           + bo_factors(index2) &
+                           + bo_factors(index3) &
+                           + bo_factors(index4) )/4.d0
+
+                      ! force on atom 4:
+                      quad_forces(1:3,4) = ( tmp_forces(1:3,4)*cut_factors(1)*cut_factors(2)*cut_factors(3) - &
+                           cut_gradients(1:3,3)*cut_factors(1)*cut_factors(2)*tmp_energy ) * &
+                           ( bo_factors(index1) &
+                           + bo_factors(index2) &
+                           + bo_factors(index3) &
+                           + bo_factors(index4) )/4.d0
+
+                      forces(1:3,index1) = forces(1:3,index1) + quad_forces(1:3,1)
+                      forces(1:3,index2) = forces(1:3,index2) + quad_forces(1:3,2)
+                      forces(1:3,index3) = forces(1:3,index3) + quad_forces(1:3,3)
+                      forces(1:3,index4) = forces(1:3,index4) + quad_forces(1:3,4)
+                        
+                   !***************!
+                   ! stress tensor !
+                   !***************!
+                   
+                   ! s_xx, s_yy, s_zz, s_yz, s_xz, s_xy:
+                   stress(1) = stress(1) + separations(1,1) * quad_forces(1,2) &
+                        + (separations(1,1) + separations(1,2)) * quad_forces(1,3) &
+                        + (separations(1,1) + separations(1,2) + separations(1,3)) * quad_forces(1,4)
+                   stress(2) = stress(2) + separations(2,1) * quad_forces(2,2) &
+                        + (separations(2,1) + separations(2,2)) * quad_forces(2,3) &
+                        + (separations(2,1) + separations(2,2) + separations(2,3)) * quad_forces(2,4)
+                   stress(3) = stress(3) + separations(3,1) * quad_forces(3,2) &
+                        + (separations(3,1) + separations(3,2)) * quad_forces(3,3) &
+                        + (separations(3,1) + separations(3,2) + separations(3,3)) * quad_forces(3,4)
+                   stress(4) = stress(4) + separations(2,1) * quad_forces(3,2) &
+                        + (separations(2,1) + separations(2,2)) * quad_forces(3,3) &
+                        + (separations(2,1) + separations(2,2) + separations(2,3)) * quad_forces(3,4)
+                   stress(5) = stress(5) + separations(1,1) * quad_forces(3,2) &
+                        + (separations(1,1) + separations(1,2)) * quad_forces(3,3) &
+                        + (separations(1,1) + separations(1,2) + separations(1,3)) * quad_forces(3,4)
+                   stress(6) = stress(6) + separations(1,1) * quad_forces(2,2) &
+                        + (separations(1,1) + separations(1,2)) * quad_forces(2,3) &
+                        + (separations(1,1) + separations(1,2) + separations(1,3)) * quad_forces(2,4)
+
+
+                   case(electronegativity_evaluation_index)
+
+                      !**************************!
+                      ! 4-body electronegativity !
+                      !**************************!
+
+                      ! If a smooth cutoff is present, we add the
+                      ! contribution it brings:
+                      if(interaction%smoothened)then
+                         ! get f(r_ij)
+                         call smoothening_factor(distances(1),&
+                              interaction%cutoff,interaction%soft_cutoff,&
+                              cut_factors(1)) ! in Potentials.f90
+                         ! get f(r_jk)
+                         call smoothening_factor(distances(2),&
+                              interaction%cutoff,interaction%soft_cutoff,&
+                              cut_factors(2)) ! in Potentials.f90
+                         ! get f(r_kl)
+                         call smoothening_factor(distances(3),&
+                              interaction%cutoff,interaction%soft_cutoff,&
+                              cut_factors(3)) ! in Potentials.f90
+                      else
+                         cut_factors(1:2) = 1.d0
+                      end if
+
+                      ! If there is a bond order factor associated with the potential,
+                      ! we add the contribution is brings:
+                      if(interaction%pot_index > -1)then
+                         ! get b_i (for all i, they have been precalculated)
+                         call core_get_bond_order_factors(interaction%pot_index,&
+                              bo_factors) ! in Potentials.f90
+                      else
+                         bo_factors = 1.d0
+                      end if
+
+                      ! evaluate the 4-body e-neg
+                      call evaluate_electronegativity(4,interaction%n_product,separations(1:3,1:3),&
+                           distances(1:3),interaction,&
+                           tmp_enegs(1:4),atom_quadruplet) ! in Potentials.f90
+
+
+                      ! e-neg on atom 1:
+                      enegs(index1) = enegs(index1) + &
+                           ( tmp_enegs(1)*cut_factors(1)*cut_factors(2)*cut_factors(3) ) * &
+                           ( bo_factors(index1) &
+                           + bo_factors(index2) &
+                           + bo_factors(index3) &
+                           + bo_factors(index4) )/4.d0
+
+                      ! e-neg on atom 2:
+                      enegs(index2) = enegs(index2) + &
+                           ( tmp_enegs(2)*cut_factors(1)*cut_factors(2)*cut_factors(3) ) * &
+                           ( bo_factors(index1) &
+                           + bo_factors(index2) &
+                           + bo_factors(index3) &
+                           + bo_factors(index4) )/4.d0
+
+                      ! e-neg on atom 3:
+                      enegs(index3) = enegs(index3) + &
+                           ( tmp_enegs(3)*cut_factors(1)*cut_factors(2)*cut_factors(3) ) * &
+                           ( bo_factors(index1) &
+                           + bo_factors(index2) &
+                           + bo_factors(index3) &
+                           + bo_factors(index4) )/4.d0
+
+                   end select
+
+                end if
+             end if
+
+          end if
+       end if
+    end do
+
+  end subroutine core_evaluate_local_quadruplet
+
+
+
+
+
+
+
+  ! Evaluates the interactions affecting four atoms. (Rearranged internally.)
+  !
+  ! *n_atoms total number of atoms in the system
+  ! *index1 index of the atom 1
+  ! *index2 index of the atom 2
+  ! *index3 index of the atom 3
+  ! *index4 index of the atom 4
+  ! *atom_quadruplet the atoms that are targeted
+  ! *test_index1 if 1, test if the ineraction targets atom1; similarly for 2, 3
+  ! *test_index2 if 1, test if the ineraction targets atom1; similarly for 2, 3
+  ! *test_index3 if 1, test if the ineraction targets atom1; similarly for 2, 3
+  ! *interaction_indices the interactions targeting the given atoms
+  ! *separations distance vector from 1 to 2, 2 to 3 and 3 to 4 as an array
+  ! *directions unit vector from 1 to 2, 2 to 3 and 3 to 4 as an array
+  ! *distances distance from 1 to 2, 2 to 3 and 3 to 4 as an array
+  ! *calculation_type the type of information requested
+  ! *energy calculated energy
+  ! *forces calculated forces
+  ! *stress calculated stress
+  ! *enegs calculated electronegativities
+  ! *many_bodies_found returns true if the loop finds an interaction with 3 or more targets
+  subroutine core_evaluate_local_quadruplet_B(atom_quadruplet, &
+       index1, index2, index3, index4, &
+       test_index1, test_index2, test_index3, &
+       !interaction_indices, &
+       separations, directions, distances, &
+       calculation_type,energy,forces,enegs,stress, &
+       many_bodies_found, &
+       manybody_indices, &
+       n_manybody )
+    implicit none
+    integer, intent(in) :: calculation_type, index1, index2, index3, index4, &
+         test_index1, test_index2, test_index3, n_manybody
+    !integer, pointer :: interaction_indices(:)
+    integer, pointer :: manybody_indices(:)
+    double precision, intent(inout) :: energy, forces(:,:), enegs(:), stress(6)
+    double precision, intent(in) :: separations(3,3), directions(3,3), distances(3)
+    logical, intent(out) :: many_bodies_found
+    type(atom), intent(in) :: atom_quadruplet(4)
+
+    type(atom) :: atom1, atom2, atom3, atom4
+    integer :: k, n_targets, n_atoms
+    type(potential) :: interaction
+    double precision :: tmp_energy, tmp_forces(3,4), tmp_enegs(4), prefactor, &
+         cut_factors(3), cut_gradients(3,3), quad_forces(3,4), bo_virial(6,4)
+    logical :: is_active
+
+    n_atoms = size(atoms)
+    many_bodies_found = .false.
+    atom1 = atom_quadruplet(1)
+    atom2 = atom_quadruplet(2)
+    atom3 = atom_quadruplet(3)
+    atom4 = atom_quadruplet(3)
+
+    ! loop over the potentials affecting atom1
+    do k = 1, n_manybody !size(interaction_indices)
+
+       interaction = interactions(manybody_indices(k))
+       call get_number_of_targets_of_potential_index(interaction%type_index,&
+            n_targets) ! in Potentials.f90
+       call potential_affects_atom(interaction,atom_quadruplet(test_index1),is_active,2) ! in Potentials.f90
+
+       ! filter the potentials by:
+       ! is atom2 affected by the potential,
+       ! is atom3 affected by the potential,
+       ! is atom4 affected by the potential,
+       ! is it a 4-body potential
+       if( is_active .and. n_targets == 4 .and. interaction%cutoff > distances(1) )then
+          call potential_affects_atom(interaction,atom_quadruplet(test_index2),is_active,3)  ! in Potentials.f90
+          if( is_active )then
+             call potential_affects_atom(interaction,atom_quadruplet(test_index3),is_active,4)  ! in Potentials.f90
+             if( is_active )then
+                if( interaction%cutoff > distances(2) .and. interaction%cutoff > distances(3) )then
+
+                   ! differentiate between energy, force, and electronegativity evaluation
+                   select case(calculation_type)
+                   case(energy_evaluation_index)
+
+                      !***************!
+                      ! 4-body energy !
+                      !***************!
+
+                      ! If there is a bond order factor associated with the potential,
+                      ! we add the contribution is brings:
+                      !
+                      ! V = \sum_ijkl b_ijkl v_ijkl
+                      ! b_ijkl = (b_i + b_j + b_k + b_l) / 4
+                      if(interaction%pot_index > -1)then
+                         ! get b_i (they have been precalculated)
+                         call core_get_bond_order_factor_of_atom(interaction%pot_index,&
+                              index1,bo_factors(index1))
+                         call core_get_bond_order_factor_of_atom(interaction%pot_index,&
+                              index2,bo_factors(index2))
+                         call core_get_bond_order_factor_of_atom(interaction%pot_index,&
+                              index3,bo_factors(index3))
+                      else
+                         !bo_factors = 1.d0
+                      end if
+
+                      ! If a smooth cutoff is present, we add the
+                      ! contribution it brings:
+                      ! 
+                      ! V = \sum_ijkl v_ijkl f(r_ij) f(r_jk) f(r_kl)
+                      if(interaction%smoothened)then
+                         ! get f(r_ij)
+                         call smoothening_factor(distances(1),&
+                              interaction%cutoff,interaction%soft_cutoff,&
+                              cut_factors(1))
+                         ! get f(r_jk)
+                         call smoothening_factor(distances(2),&
+                              interaction%cutoff,interaction%soft_cutoff,&
+                              cut_factors(2))
+                         ! get f(r_kl)
+                         call smoothening_factor(distances(3),&
+                              interaction%cutoff,interaction%soft_cutoff,&
+                              cut_factors(3))
+                      else
+                         cut_factors(1:3) = 1.d0
+                      end if
+
+                      ! evaluate the 4-body energy
+                      call evaluate_energy(4,interaction%n_product,separations(1:3,1:3),distances(1:3),&
+                           interaction,tmp_energy,atom_quadruplet)
+
+                      if(interaction%pot_index > -1)then
+                         ! add the term: b_ijkl v_ijkl f(r_ij) f(r_jk) f(r_lk)
+                         energy = energy + tmp_energy*cut_factors(1)*cut_factors(2)*cut_factors(3)*&
+                              (bo_factors(index1)+bo_factors(index2)+bo_factors(index3)+bo_factors(index3))/4.d0
+                      else
+                         energy = energy + tmp_energy*cut_factors(1)*cut_factors(2)*cut_factors(3)
+                      end if
+
+
+                   case(force_evaluation_index)
+
+                      !**************!
+                      ! 4-body force !
+                      !**************!
+
+                      ! We will need the energy contribution 
+                      ! if smooth cutoffs or bond factors are used,
+                      ! since we are mulplying the potential.
+                      if((interaction%pot_index > -1) .or. &
+                           interaction%smoothened)then
+                         call evaluate_energy(4,interaction%n_product,separations(1:3,1:3),distances(1:3),&
+                              interaction,tmp_energy,atom_quadruplet) ! in Potentials.f90
+                      else
+                         tmp_energy = 0.d0
+                      end if
+
+                      ! If a smooth cutoff is present, we add the
+                      ! contribution it brings:
+                      ! 
+                      ! V = \sum_ijkl v_ijkl f(r_ij) f(r_jk) f(r_kl)
+                      ! F_a = - \nabla_a V 
+                      !     = - \sum_ijkl ( v_ijkl f'(r_ij) f(r_jk) f(r_kl) (\nabla_a r_ij) + 
+                      !                   v_ijkl f(r_ij) f'(r_jk) f(r_kl) (\nabla_a r_jk) + 
+                      !                   v_ijkl f(r_ij) f(r_jk) f'(r_kl) (\nabla_a r_kl) +
+                      !                   (\nabla_a v_ijkl) f(r_ij) f(r_jk) f(r_kl) )
+                      !
+                      if(interaction%smoothened)then
+                         ! get f(r_ij)
+                         call smoothening_factor(distances(1),&
+                              interaction%cutoff,interaction%soft_cutoff,&
+                              cut_factors(1)) ! in Potentials.f90
+                         ! get f'(r_ij) (\nabla_a r_ij)
+                         call smoothening_gradient(directions(1:3,1),distances(1),&
+                              interaction%cutoff,interaction%soft_cutoff,&
+                              cut_gradients(1:3,1)) ! in Potentials.f90 
+                         ! get f(r_jk)
+                         call smoothening_factor(distances(2),&
+                              interaction%cutoff,interaction%soft_cutoff,&
+                              cut_factors(2)) ! in Potentials.f90
+                         ! get f'(r_jk) (\nabla_a r_ik)
+                         call smoothening_gradient(directions(1:3,2),distances(2),&
+                              interaction%cutoff,interaction%soft_cutoff,&
+                              cut_gradients(1:3,2)) ! in Potentials.f90
+                         ! get f(r_kl)
+                         call smoothening_factor(distances(3),&
+                              interaction%cutoff,interaction%soft_cutoff,&
+                              cut_factors(3)) ! in Potentials.f90
+                         ! get f'(r_kl) (\nabla_a r_kl)
+                         call smoothening_gradient(directions(1:3,3),distances(3),&
+                              interaction%cutoff,interaction%soft_cutoff,&
+                              cut_gradients(1:3,3)) ! in Potentials.f90
+                      else
+                         cut_factors(1:3) = 1.d0
+                         cut_gradients(1:3,1:3) = 0.d0
+                      end if
+
+
+                      ! If there is a bond order factor associated with the potential,
+                      ! we add the contribution is brings:
+                      !
+                      ! V = \sum_ijkl b_ijkl v_ijkl
+                      ! b_ijkl = (b_i + b_j + b_k + b_l) / 4
+                      ! F_a = - \nabla_a V 
+                      !     = - \sum_ijkl (\nabla_a b_ijkl) v_ijkl + b_ijkl (\nabla_a v_ijkl)
+                      !     = - \sum_ijkl (\nabla_a b_ijkl) v_ijkl + b_ijkl f_a,ijkl
+                      !
+                      if(interaction%pot_index > -1)then
+                         ! get b_i (for all i, they have been precalculated)
+                         call core_get_bond_order_factors(interaction%pot_index,&
+                              bo_factors) ! in Potentials.f90
+
+                         prefactor = -tmp_energy*cut_factors(1)*cut_factors(2)*cut_factors(3)*0.25d0
+                         call core_add_bond_order_forces( &
+                              interaction%pot_index, index1, prefactor, &
+                              forces, stress )
+                         call core_add_bond_order_forces( &
+                              interaction%pot_index, index2, prefactor, &
+                              forces, stress )
+                         call core_add_bond_order_forces( &
+                              interaction%pot_index, index3, prefactor, &
+                              forces, stress )
+                         call core_add_bond_order_forces( &
+                              interaction%pot_index, index4, prefactor, &
+                              forces, stress )
+
+!!$                         ! get (\nabla_a b_i) (for all a)
+!!$                         call core_get_bond_order_gradients(interaction%pot_index,&
+!!$                              index1,& ! atom index
+!!$                              1, & ! slot_index
+!!$                              bo_gradients(1:3,1:n_atoms,1), &
+!!$                              bo_virial(1:6,1)) ! in Potentials.f90
+!!$                         ! get (\nabla_a b_j) (for all a)
+!!$                         call core_get_bond_order_gradients(interaction%pot_index,&
+!!$                              index2,& ! atom index
+!!$                              2, & ! slot_index
+!!$                              bo_gradients(1:3,1:n_atoms,2), &
+!!$                              bo_virial(1:6,2)) ! in Potentials.f90
+!!$                         ! get (\nabla_a b_k) (for all a)
+!!$                         call core_get_bond_order_gradients(interaction%pot_index,&
+!!$                              index3,& ! atom index
+!!$                              3, & ! slot_index
+!!$                              bo_gradients(1:3,1:n_atoms,3), &
+!!$                              bo_virial(1:6,3)) ! in Potentials.f90
+!!$                         ! get (\nabla_a b_l) (for all a)
+!!$                         call core_get_bond_order_gradients(interaction%pot_index,&
+!!$                              index4,& ! atom index
+!!$                              4, & ! slot_index
+!!$                              bo_gradients(1:3,1:n_atoms,4), &
+!!$                              bo_virial(1:6,4)) ! in Potentials.f90
+!!$
+!!$                         ! Add the bond order gradient terms involving the 
+!!$                         ! atom2-atom1-atom3 energy for all atoms.
+!!$                         ! That is, add the (\nabla_a b_ijk) v_ijk term with 
+!!$                         ! the given ijk (atom2,atom1,atom3) for all a.
+!!$                         forces(1:3,1:n_atoms) = forces(1:3,1:n_atoms) &
+!!$                              - tmp_energy*cut_factors(1)*cut_factors(2)*cut_factors(3)* &
+!!$                              ( bo_gradients(1:3,1:n_atoms,1) &
+!!$                              + bo_gradients(1:3,1:n_atoms,2) &
+!!$                              + bo_gradients(1:3,1:n_atoms,3) &
+!!$                              + bo_gradients(1:3,1:n_atoms,4) )/4.d0
+!!$
+!!$                         stress(1:6) = stress(1:6) - tmp_energy*cut_factors(1)*cut_factors(2)*cut_factors(3)* &
+!!$                              ( bo_virial(1:6,1) &
+!!$                              + bo_virial(1:6,2) &
+!!$                              + bo_virial(1:6,3) &
+!!$                              + bo_virial(1:6,4) )/4.d0
+
+                      else
+                         !bo_factors = 1.d0
+                         !bo_sums = 0.d0
+                         !bo_gradients = 0.d0
+                      end if
+
+
+                      ! evaluate the 4-body force
+                      call evaluate_forces(4,interaction%n_product,separations(1:3,1:3),distances(1:3),interaction,&
+                           tmp_forces(1:3,1:4),atom_quadruplet) ! in Potentials.f90
+
+                      if(interaction%pot_index > -1)then
+                         ! force on atom 1:
+                         quad_forces(1:3,1) = ( tmp_forces(1:3,1)*cut_factors(1)*cut_factors(2)*cut_factors(3) + &
+                              cut_gradients(1:3,1)*cut_factors(2)*cut_factors(3)*tmp_energy ) * &
+                              ( bo_factors(index1) &
+                              + bo_factors(index2) &
+                              + bo_factors(index3) &
+                              + bo_factors(index4) )/4.d0
+                         
+                         ! force on atom 2:
+                         quad_forces(1:3,2) = ( tmp_forces(1:3,2)*cut_factors(1)*cut_factors(2)*cut_factors(3) + &
+                              (-cut_gradients(1:3,1)*cut_factors(2)*cut_factors(3) + &
+                              cut_gradients(1:3,2)*cut_factors(1)*cut_factors(3)) * tmp_energy ) * &
+                              ( bo_factors(index1) &
+                              + bo_factors(index2) &
+                              + bo_factors(index3) &
+                              + bo_factors(index4) )/4.d0
+                         
+                         ! force on atom 3:
+                         quad_forces(1:3,3) = ( tmp_forces(1:3,3)*cut_factors(1)*cut_factors(2)*cut_factors(3) + &
+                              (cut_gradients(1:3,3)*cut_factors(1)*cut_factors(2) - &
+                              cut_gradients(1:3,2)*cut_factors(1)*cut_factors(3)) * tmp_energy ) * &
+                              ( bo_factors(index1) &
+                              + bo_factors(index2) &
+                              + bo_factors(index3) &
+                              + bo_factors(index4) )/4.d0
+                         
+                         ! force on atom 4:
+                         quad_forces(1:3,4) = ( tmp_forces(1:3,4)*cut_factors(1)*cut_factors(2)*cut_factors(3) - &
+                              cut_gradients(1:3,3)*cut_factors(1)*cut_factors(2)*tmp_energy ) * &
+                              ( bo_factors(index1) &
+                              + bo_factors(index2) &
+                              + bo_factors(index3) &
+                              + bo_factors(index4) )/4.d0
+
+                      else
+                         ! force on atom 1:
+                         quad_forces(1:3,1) = ( tmp_forces(1:3,1)*cut_factors(1)*cut_factors(2)*cut_factors(3) + &
+                              cut_gradients(1:3,1)*cut_factors(2)*cut_factors(3)*tmp_energy )
+                         
+                         ! force on atom 2:
+                         quad_forces(1:3,2) = ( tmp_forces(1:3,2)*cut_factors(1)*cut_factors(2)*cut_factors(3) + &
+                              (-cut_gradients(1:3,1)*cut_factors(2)*cut_factors(3) + &
+                              cut_gradients(1:3,2)*cut_factors(1)*cut_factors(3)) * tmp_energy ) 
+                         
+                         ! force on atom 3:
+                         quad_forces(1:3,3) = ( tmp_forces(1:3,3)*cut_factors(1)*cut_factors(2)*cut_factors(3) + &
+                              (cut_gradients(1:3,3)*cut_factors(1)*cut_factors(2) - &
+                              cut_gradients(1:3,2)*cut_factors(1)*cut_factors(3)) * tmp_energy ) 
+                         
+                         ! force on atom 4:
+                         quad_forces(1:3,4) = ( tmp_forces(1:3,4)*cut_factors(1)*cut_factors(2)*cut_factors(3) - &
+                              cut_gradients(1:3,3)*cut_factors(1)*cut_factors(2)*tmp_energy ) 
+
+                      end if
+
+                      forces(1:3,index1) = forces(1:3,index1) + quad_forces(1:3,1)
+                      forces(1:3,index2) = forces(1:3,index2) + quad_forces(1:3,2)
+                      forces(1:3,index3) = forces(1:3,index3) + quad_forces(1:3,3)
+                      forces(1:3,index4) = forces(1:3,index4) + quad_forces(1:3,4)
+                        
+                   !***************!
+                   ! stress tensor !
+                   !***************!
+                   
+                   ! s_xx, s_yy, s_zz, s_yz, s_xz, s_xy:
+                   stress(1) = stress(1) + separations(1,1) * quad_forces(1,2) &
+                        + (separations(1,1) + separations(1,2)) * quad_forces(1,3) &
+                        + (separations(1,1) + separations(1,2) + separations(1,3)) * quad_forces(1,4)
+                   stress(2) = stress(2) + separations(2,1) * quad_forces(2,2) &
+                        + (separations(2,1) + separations(2,2)) * quad_forces(2,3) &
+                        + (separations(2,1) + separations(2,2) + separations(2,3)) * quad_forces(2,4)
+                   stress(3) = stress(3) + separations(3,1) * quad_forces(3,2) &
+                        + (separations(3,1) + separations(3,2)) * quad_forces(3,3) &
+                        + (separations(3,1) + separations(3,2) + separations(3,3)) * quad_forces(3,4)
+                   stress(4) = stress(4) + separations(2,1) * quad_forces(3,2) &
+                        + (separations(2,1) + separations(2,2)) * quad_forces(3,3) &
+                        + (separations(2,1) + separations(2,2) + separations(2,3)) * quad_forces(3,4)
+                   stress(5) = stress(5) + separations(1,1) * quad_forces(3,2) &
+                        + (separations(1,1) + separations(1,2)) * quad_forces(3,3) &
+                        + (separations(1,1) + separations(1,2) + separations(1,3)) * quad_forces(3,4)
+                   stress(6) = stress(6) + separations(1,1) * quad_forces(2,2) &
+                        + (separations(1,1) + separations(1,2)) * quad_forces(2,3) &
+                        + (separations(1,1) + separations(1,2) + separations(1,3)) * quad_forces(2,4)
 
-             if( interaction%cutoff > distances(2) )then
 
+                   case(electronegativity_evaluation_index)
 
-                ! differentiate between energy, force, and electronegativity evaluation
-                select case(calculation_type)
-                case(energy_evaluation_index)
+                      !**************************!
+                      ! 4-body electronegativity !
+                      !**************************!
 
-                   !***********************************!
-                   ! 3-body energy (atom1-atom2-atom3) !
-                   !***********************************!
+                      ! If a smooth cutoff is present, we add the
+                      ! contribution it brings:
+                      if(interaction%smoothened)then
+                         ! get f(r_ij)
+                         call smoothening_factor(distances(1),&
+                              interaction%cutoff,interaction%soft_cutoff,&
+                              cut_factors(1)) ! in Potentials.f90
+                         ! get f(r_jk)
+                         call smoothening_factor(distances(2),&
+                              interaction%cutoff,interaction%soft_cutoff,&
+                              cut_factors(2)) ! in Potentials.f90
+                         ! get f(r_kl)
+                         call smoothening_factor(distances(3),&
+                              interaction%cutoff,interaction%soft_cutoff,&
+                              cut_factors(3)) ! in Potentials.f90
+                      else
+                         cut_factors(1:2) = 1.d0
+                      end if
 
+                      ! If there is a bond order factor associated with the potential,
+                      ! we add the contribution is brings:
+                      if(interaction%pot_index > -1)then
+                         ! get b_i (for all i, they have been precalculated)
+                         call core_get_bond_order_factors(interaction%pot_index,&
+                              bo_factors) ! in Potentials.f90
+                      else
+                         !bo_factors = 1.d0
+                      end if
 
-                   ! If there is a bond order factor associated with the potential,
-                   ! we add the contribution is brings:
-                   !
-                   ! V = \sum_ijk b_ijk v_ijk
-                   ! b_ijk = (b_i + b_j + b_k) / 3
-                   if(interaction%pot_index > -1)then
-                      ! get b_i (for all i, they have been precalculated)
-                      call core_get_bond_order_factors(interaction%pot_index,&
-                           bo_factors)
-                   else
+                      ! evaluate the 4-body e-neg
+                      call evaluate_electronegativity(4,interaction%n_product,separations(1:3,1:3),&
+                           distances(1:3),interaction,&
+                           tmp_enegs(1:4),atom_quadruplet) ! in Potentials.f90
 
-                   end if
 
-                   ! If a smooth cutoff is present, we add the
-                   ! contribution it brings:
-                   ! 
-                   ! V = \sum_ijk v_ijk f(r_ij) f(r_ik)
-                   if(interaction%smoothened)then
-                      ! get f(r_ij)
-                      call smoothening_factor(distances(1),&
-                           interaction%cutoff,interaction%soft_cutoff,&
-                           cut_factors(1))
-                      ! get f(r_ik)
-                      call smoothening_factor(distances(2),&
-                           interaction%cutoff,interaction%soft_cutoff,&
-                           cut_factors(2))
-                   else
-                      cut_factors(1:2) = 1.d0
-                   end if
+                      if(interaction%pot_index > -1)then
+                         ! e-neg on atom 1:
+                         enegs(index1) = enegs(index1) + &
+                              ( tmp_enegs(1)*cut_factors(1)*cut_factors(2)*cut_factors(3) ) * &
+                              ( bo_factors(index1) &
+                              + bo_factors(index2) &
+                              + bo_factors(index3) &
+                              + bo_factors(index4) )/4.d0
+                         
+                         ! e-neg on atom 2:
+                         enegs(index2) = enegs(index2) + &
+                              ( tmp_enegs(2)*cut_factors(1)*cut_factors(2)*cut_factors(3) ) * &
+                              ( bo_factors(index1) &
+                              + bo_factors(index2) &
+                              + bo_factors(index3) &
+                              + bo_factors(index4) )/4.d0
+                         
+                         ! e-neg on atom 3:
+                         enegs(index3) = enegs(index3) + &
+                              ( tmp_enegs(3)*cut_factors(1)*cut_factors(2)*cut_factors(3) ) * &
+                              ( bo_factors(index1) &
+                              + bo_factors(index2) &
+                              + bo_factors(index3) &
+                              + bo_factors(index4) )/4.d0
 
-                   ! evaluate the 3-body energy involving atom2-atom1-atom3 interaction
-                   call evaluate_energy(3,interaction%n_product,separations(1:3,1:2),distances(1:2),&
-                        interaction,tmp_energy,atom_triplet)
+                         ! e-neg on atom 4:
+                         enegs(index4) = enegs(index4) + &
+                              ( tmp_enegs(4)*cut_factors(1)*cut_factors(2)*cut_factors(3) ) * &
+                              ( bo_factors(index1) &
+                              + bo_factors(index2) &
+                              + bo_factors(index3) &
+                              + bo_factors(index4) )/4.d0
+                      else
+                         ! e-neg on atom 1:
+                         enegs(index1) = enegs(index1) + &
+                              ( tmp_enegs(1)*cut_factors(1)*cut_factors(2)*cut_factors(3) )
+                         
+                         ! e-neg on atom 2:
+                         enegs(index2) = enegs(index2) + &
+                              ( tmp_enegs(2)*cut_factors(1)*cut_factors(2)*cut_factors(3) ) 
+                         
+                         ! e-neg on atom 3:
+                         enegs(index3) = enegs(index3) + &
+                              ( tmp_enegs(3)*cut_factors(1)*cut_factors(2)*cut_factors(3) ) 
 
-                   if(interaction%pot_index > -1)then
-                      ! add the term: b_ijk v_ijk f(r_ij) f(r_ik)
-                      energy = energy + tmp_energy*cut_factors(1)*cut_factors(2)*&
-                           (bo_factors(index1)+bo_factors(index2)+bo_factors(index3))/3.d0
-                   else
-                      energy = energy + tmp_energy*cut_factors(1)*cut_factors(2)
-                   end if
+                         ! e-neg on atom 4:
+                         enegs(index4) = enegs(index4) + &
+                              ( tmp_enegs(4)*cut_factors(1)*cut_factors(2)*cut_factors(3) ) 
+                      end if
 
-                case(force_evaluation_index)
+                   end select
 
-                   !**************!
-                   ! 3-body force !
-                   !**************!
+                end if
+             end if
 
+          end if
+       end if
+    end do
 
-                   ! We will need the energy contribution 
-                   ! if smooth cutoffs or bond factors are used,
-                   ! since we are mulplying the potential.
-                   if((interaction%pot_index > -1) .or. &
-                        interaction%smoothened)then
-                      call evaluate_energy(3,interaction%n_product,separations(1:3,1:2),distances(1:2),&
-                           interaction,tmp_energy,atom_triplet) ! in Potentials.f90
-                   else
-                      tmp_energy = 0.d0
-                   end if
+  end subroutine core_evaluate_local_quadruplet_B
 
-                   ! If a smooth cutoff is present, we add the
-                   ! contribution it brings:
-                   ! 
-                   ! V = \sum_ijk v_ijk f(r_ij) f(r_ik)
-                   ! F_a = - \nabla_a V 
-                   !     = - \sum_ij ( v_ij f'(r_ij) f(r_ik) (\nabla_a r_ij) + 
-                   !                   v_ij f(r_ij) f'(r_ik) (\nabla_a r_ik) +
-                   !                   (\nabla_a v_ij) f(r_ij) f(r_ik) )
-                   !
-                   if(interaction%smoothened)then
-                      ! get f(r_ij)
-                      call smoothening_factor(distances(1),&
-                           interaction%cutoff,interaction%soft_cutoff,&
-                           cut_factors(1)) ! in Potentials.f90
-                      ! get f'(r_ij) (\nabla_a r_ij)
-                      call smoothening_gradient(directions(1:3,1),distances(1),&
-                           interaction%cutoff,interaction%soft_cutoff,&
-                           cut_gradients(1:3,1)) ! in Potentials.f90 
-                      ! get f(r_jk)
-                      call smoothening_factor(distances(2),&
-                           interaction%cutoff,interaction%soft_cutoff,&
-                           cut_factors(2)) ! in Potentials.f90
-                      ! get f'(r_jk) (\nabla_a r_jk)
-                      call smoothening_gradient(directions(1:3,2),distances(2),&
-                           interaction%cutoff,interaction%soft_cutoff,&
-                           cut_gradients(1:3,2)) ! in Potentials.f90
-                   else
-                      cut_factors(1:2) = 1.d0
-                      cut_gradients(1:3,1:2) = 0.d0
-                   end if
 
-                   ! If there is a bond order factor associated with the potential,
-                   ! we add the contribution is brings:
-                   !
-                   ! V = \sum_ijk b_ijk v_ijk
-                   ! b_ijk = (b_i + b_j + b_k) / 3
-                   ! F_a = - \nabla_a V 
-                   !     = - \sum_ijk (\nabla_a b_ijk) v_ijk + b_ijk (\nabla_a v_ijk)
-                   !     = - \sum_ijk (\nabla_a b_ijk) v_ijk + b_ij f_a,ijk
-                   !
-                   if(interaction%pot_index > -1)then
-                      ! get b_i (for all i, they have been precalculated)
-                      call core_get_bond_order_factors(interaction%pot_index,&
-                           bo_factors)
-                      
-                      prefactor = tmp_energy*cut_factors(1)*cut_factors(2)/3.d0
 
-                      call core_add_bond_order_forces( &
-                           interaction%pot_index, index1, prefactor, &
-                           forces, stress )
 
-                      call core_add_bond_order_forces( &
-                           interaction%pot_index, index2, prefactor, &
-                           forces, stress )
 
-                      call core_add_bond_order_forces( &
-                           interaction%pot_index, index3, prefactor, &
-                           forces, stress )
 
-!!$                      ! get (\nabla_a b_i) (for all a)
-!!$                      call core_get_bond_order_gradients(interaction%pot_index,&
-!!$                           index1,& ! atom index
-!!$                           1, & ! slot_index
-!!$                           bo_gradients(1:3,1:n_atoms,1), &
-!!$                           bo_virial(1:6,1))
-!!$                      ! get (\nabla_a b_j) (for all a)
-!!$                      call core_get_bond_order_gradients(interaction%pot_index,&
-!!$                           index2,& ! atom index
-!!$                           2, & ! slot_index
-!!$                           bo_gradients(1:3,1:n_atoms,2), &
-!!$                           bo_virial(1:6,2))
-!!$                      ! get (\nabla_a b_k) (for all a)
-!!$                      call core_get_bond_order_gradients(interaction%pot_index,&
-!!$                           index3,& ! atom index
-!!$                           3, & ! slot_index
-!!$                           bo_gradients(1:3,1:n_atoms,3), &
-!!$                           bo_virial(1:6,3))
-!!$
-!!$
-!!$                      ! Add the bond order gradient terms involving the 
-!!$                      ! atom2-atom1-atom3 energy for all atoms.
-!!$                      ! That is, add the (\nabla_a b_ijk) v_ijk term with 
-!!$                      ! the given ijk (atom2,atom1,atom3) for all a.
-!!$                      forces(1:3,1:n_atoms) = forces(1:3,1:n_atoms) &
-!!$                           - tmp_energy*cut_factors(1)*cut_factors(2)*&
-!!$                           ( bo_gradients(1:3,1:n_atoms,1) &
-!!$                           + bo_gradients(1:3,1:n_atoms,2) &
-!!$                           + bo_gradients(1:3,1:n_atoms,3) )/3.d0
-!!$
-!!$                      stress(1:6) = stress(1:6) - tmp_energy*cut_factors(1)*cut_factors(2)*&
-!!$                           ( bo_virial(1:6,1) &
-!!$                           + bo_virial(1:6,2) &
-!!$                           + bo_virial(1:6,3) )/3.d0
+! !!!: core_calculate_forces
+
+  ! Calculates forces acting on all atoms of the system.
+  !
+  ! The routine calculates the potential gradient
+  !
+  ! .. math::
+  !
+  !    \mathbf{F}_\alpha = - \nabla_\alpha V
+  !
+  ! for all atoms :math:`\alpha`. This is done according to the
+  ! the structure and potentials allocated in the core, so the
+  ! routine does not accept arguments. Instead, the core modifying
+  ! routines such as :func:`core_generate_atoms` must be called
+  ! first to set up the calculation.
+  !
+  ! called from PyInterface: :func:`calculate_forces`
+  !
+  ! *total_forces an array containing the calculated forces for all atoms
+  ! *total_stress as array containing the calculated stress tensor
+  subroutine core_calculate_forces(total_forces,total_stress)
+    implicit none
+    double precision, intent(inout) :: total_forces(:,:), total_stress(6)
+    double precision :: dummy_energy
 
-                   else
-                      !bo_factors = 1.d0
-                      !bo_sums = 0.d0
-                      !bo_gradients = 0.d0
-                   end if
+    call core_loop_over_local_interactions(force_evaluation_index,&
+         dummy_energy,total_forces,temp_enegs,total_stress)
 
-                   ! evaluate the 3-body force
-                   call evaluate_forces(3,interaction%n_product,separations(1:3,1:2),distances(1:2),interaction,&
-                        tmp_forces(1:3,1:3),atom_triplet) ! in Potentials.f90
+  end subroutine core_calculate_forces
 
-                   if(interaction%pot_index > -1)then
-                      ! force on atom 1:
-                      triplet_forces(1:3,1) = ( tmp_forces(1:3,1)*cut_factors(1)*cut_factors(2) + &
-                           cut_gradients(1:3,1)*cut_factors(2)*tmp_energy ) * &
-                           ( bo_factors(index1) &
-                           + bo_factors(index2) &
-                           + bo_factors(index3) )/3.d0
-                      
-                      ! force on atom 2:
-                      triplet_forces(1:3,2) = ( tmp_forces(1:3,2)*cut_factors(1)*cut_factors(2) + &
-                           (-cut_gradients(1:3,1)*cut_factors(2) + &
-                           cut_gradients(1:3,2)*cut_factors(1)) * tmp_energy ) * &
-                           ( bo_factors(index1) &
-                           + bo_factors(index2) &
-                           + bo_factors(index3) )/3.d0
-                      
-                      ! force on atom 3:
-                      triplet_forces(1:3,3) = ( tmp_forces(1:3,3)*cut_factors(1)*cut_factors(2) - &
-                           cut_gradients(1:3,2)*cut_factors(1)*tmp_energy ) * &
-                           ( bo_factors(index1) &
-                           + bo_factors(index2) &
-                           + bo_factors(index3) )/3.d0
-                   else
-                      ! force on atom 1:
-                      triplet_forces(1:3,1) = ( tmp_forces(1:3,1)*cut_factors(1)*cut_factors(2) + &
-                           cut_gradients(1:3,1)*cut_factors(2)*tmp_energy ) 
-                      
-                      ! force on atom 2:
-                      triplet_forces(1:3,2) = ( tmp_forces(1:3,2)*cut_factors(1)*cut_factors(2) + &
-                           (-cut_gradients(1:3,1)*cut_factors(2) + &
-                           cut_gradients(1:3,2)*cut_factors(1)) * tmp_energy ) 
-                      
-                      ! force on atom 3:
-                      triplet_forces(1:3,3) = ( tmp_forces(1:3,3)*cut_factors(1)*cut_factors(2) - &
-                           cut_gradients(1:3,2)*cut_factors(1)*tmp_energy ) 
-                      
-                   end if
 
-                   forces(1:3,index1) = forces(1:3,index1) + triplet_forces(1:3,1)
-                   forces(1:3,index2) = forces(1:3,index2) + triplet_forces(1:3,2)
-                   forces(1:3,index3) = forces(1:3,index3) + triplet_forces(1:3,3)
-                        
-                   !***************!
-                   ! stress tensor !
-                   !***************!
-                   
-                   ! s_xx, s_yy, s_zz, s_yz, s_xz, s_xy:
-                   stress(1) = stress(1) + separations(1,1) * triplet_forces(1,2) &
-                        + (separations(1,1) + separations(1,2)) * triplet_forces(1,3)
-                   stress(2) = stress(2) + separations(2,1) * triplet_forces(2,2) &
-                        + (separations(2,1) + separations(2,2)) * triplet_forces(2,3)
-                   stress(3) = stress(3) + separations(3,1) * triplet_forces(3,2) &
-                        + (separations(3,1) + separations(3,2)) * triplet_forces(3,3)
-                   stress(4) = stress(4) + separations(2,1) * triplet_forces(3,2) &
-                        + (separations(2,1) + separations(2,2)) * triplet_forces(3,3)
-                   stress(5) = stress(5) + separations(1,1) * triplet_forces(3,2) &
-                        + (separations(1,1) + separations(1,2)) * triplet_forces(3,3)
-                   stress(6) = stress(6) + separations(1,1) * triplet_forces(2,2) &
-                        + (separations(1,1) + separations(1,2)) * triplet_forces(2,3)
 
-                case(electronegativity_evaluation_index)
 
-                   !**********************************************!
-                   ! 3-body electronegativity (atom1-atom2-atom3) !
-                   !**********************************************!
 
-                   ! If a smooth cutoff is present, we add the
-                   ! contribution it brings:
-                   if(interaction%smoothened)then
-                      ! get f(r_ij)
-                      call smoothening_factor(distances(1),&
-                           interaction%cutoff,interaction%soft_cutoff,&
-                           cut_factors(1)) ! in Potentials.f90
-                      ! get f(r_ik)
-                      call smoothening_factor(distances(2),&
-                           interaction%cutoff,interaction%soft_cutoff,&
-                           cut_factors(2)) ! in Potentials.f90
-                   else
-                      cut_factors(1:2) = 1.d0
-                   end if
+! !!!: core_calculate_electronegativities
 
-                   ! If there is a bond order factor associated with the potential,
-                   ! we add the contribution is brings:
-                   if(interaction%pot_index > -1)then
-                      ! get b_i (for all i, they have been precalculated)
-                      call core_get_bond_order_factors(interaction%pot_index,&
-                           bo_factors) ! in Potentials.f90
-                   else
-                      !bo_factors = 1.d0
-                   end if
+  ! Calculates electronegativity forces acting on all atomic charges of the system.
+  !
+  ! The routine calculates the electronegativities
+  !
+  ! .. math::
+  !
+  !    \chi_{\alpha} = -\frac{\partial V}{\partial q_\alpha}
+  !
+  ! for all atoms :math:`\alpha`. This is done according to the
+  ! the structure and potentials allocated in the core, so the
+  ! routine does not accept arguments. Instead, the core modifying
+  ! routines such as :func:`core_generate_atoms` must be called
+  ! first to set up the calculation.
+  !
+  ! called from PyInterface: :func:`calculate_electronegativities`
+  !
+  ! *total_enegs an array containing the calculated charge forces for all atoms
+  subroutine core_calculate_electronegativities(total_enegs)
+    implicit none
+    double precision, intent(inout) :: total_enegs(:)
+    double precision :: dummy_energy, dummy_stress(6)
 
-                   ! evaluate the 3-body e-neg involving atom2-atom1-atom3 interaction
-                   call evaluate_electronegativity(3,interaction%n_product,separations(1:3,1:2),&
-                        distances(1:2),interaction,&
-                        tmp_enegs(1:3),atom_triplet) ! in Potentials.f90
+    call core_loop_over_local_interactions(electronegativity_evaluation_index,&
+         dummy_energy,temp_forces,total_enegs,dummy_stress)
+    return
 
-                   if(interaction%pot_index > -1)then
-                      ! e-neg on atom 1:
-                      enegs(index1) = enegs(index1) + &
-                           ( tmp_enegs(1)*cut_factors(1)*cut_factors(2) ) * &
-                           ( bo_factors(index1) &
-                           + bo_factors(index2) &
-                           + bo_factors(index3) )/3.d0
-                      
-                      ! e-neg on atom 2:
-                      enegs(index2) = enegs(index2) + &
-                           ( tmp_enegs(2)*cut_factors(1)*cut_factors(2) ) * &
-                           ( bo_factors(index1) &
-                           + bo_factors(index2) &
-                           + bo_factors(index3) )/3.d0
-                      
-                      ! e-neg on atom 3:
-                      enegs(index3) = enegs(index3) + &
-                           ( tmp_enegs(3)*cut_factors(1)*cut_factors(2) ) * &
-                           ( bo_factors(index1) &
-                           + bo_factors(index2) &
-                           + bo_factors(index3) )/3.d0
+  end subroutine core_calculate_electronegativities
 
-                   else
-                      ! e-neg on atom 1:
-                      enegs(index1) = enegs(index1) + &
-                           ( tmp_enegs(1)*cut_factors(1)*cut_factors(2) ) 
-                      
-                      ! e-neg on atom 2:
-                      enegs(index2) = enegs(index2) + &
-                           ( tmp_enegs(2)*cut_factors(1)*cut_factors(2) ) 
-                      
-                      ! e-neg on atom 3:
-                      enegs(index3) = enegs(index3) + &
-                           ( tmp_enegs(3)*cut_factors(1)*cut_factors(2) ) 
 
-                   end if
 
-                end select
 
+! !!!: core_calculate_energy
 
-             end if ! interaction%cutoff > distances(2)
+  ! Calculates the total potential energy of the system.
+  !
+  ! This is done according to the
+  ! the structure and potentials allocated in the core, so the
+  ! routine does not accept arguments. Instead, the core modifying
+  ! routines such as :func:`core_generate_atoms` must be called
+  ! first to set up the calculation.
+  !
+  ! called from PyInterface: :func:`calculate_energy`
+  !
+  ! *total_energy calculated total potential energy
+  subroutine core_calculate_energy(total_energy)
+    implicit none
+    double precision, intent(out) :: total_energy
+    double precision :: dummy_stress(6)
 
-          end if ! is_active
-       else if(n_targets > 3)then
+    call core_loop_over_local_interactions(energy_evaluation_index,&
+         total_energy,temp_forces,temp_enegs,dummy_stress)
+    return
 
-          many_bodies_found = .true.
+  end subroutine core_calculate_energy
 
-       end if ! is_active .and. n_targets == 3
 
-    end do ! k = 1, size(interaction_indices)
+  ! !!!: list_atoms
 
+  ! Prints some information on the atoms stored in the core in stdout.
+  subroutine list_atoms()
+    implicit none
+    integer :: i
 
-  end subroutine core_evaluate_local_triplet_B
+    if(associated(atoms))then
+       write(*,*) "element, position, charge"    
+       do i = 1, size(atoms)
+          write(*,'(I7,I7,A,A,F10.4,F10.4,F10.4,F10.4)') i, atoms(i)%index," ", atoms(i)%element, &
+               atoms(i)%position(1), atoms(i)%position(2), atoms(i)%position(3), atoms(i)%charge
+       end do
+    else
+       write(*,*) "no atoms defined"
+    end if
 
+  end subroutine list_atoms
 
 
+! !!!: list_cell
 
+  ! Prints some information on the supercell stored in the core in stdout.
+  subroutine list_cell()
+    implicit none
+    integer :: i
 
+    write(*,*) "cell"
+    do i = 1, 3
+        write(*,'(F10.4,F10.4,F10.4)') cell%vectors(1:3,i)
+    end do
+    write(*,*) "pbc: ", cell%periodic(1:3)
 
+  end subroutine list_cell
 
-  ! Evaluates the interactions affecting four atoms.
-  !
-  ! *n_atoms total number of atoms in the system
-  ! *index1 index of the atom 1
-  ! *index2 index of the atom 2
-  ! *index3 index of the atom 3
-  ! *index4 index of the atom 4
-  ! *atom_quadruplet the atoms that are targeted
-  ! *test_index1 if 1, test if the ineraction targets atom1; similarly for 2, 3
-  ! *test_index2 if 1, test if the ineraction targets atom1; similarly for 2, 3
-  ! *test_index3 if 1, test if the ineraction targets atom1; similarly for 2, 3
-  ! *interaction_indices the interactions targeting the given atoms
-  ! *separations distance vector from 1 to 2, 2 to 3 and 3 to 4 as an array
-  ! *directions unit vector from 1 to 2, 2 to 3 and 3 to 4 as an array
-  ! *distances distance from 1 to 2, 2 to 3 and 3 to 4 as an array
-  ! *calculation_type the type of information requested
-  ! *energy calculated energy
-  ! *forces calculated forces
-  ! *stress calculated stress
-  ! *enegs calculated electronegativities
-  ! *many_bodies_found returns true if the loop finds an interaction with 3 or more targets
-  subroutine core_evaluate_local_quadruplet(n_atoms, &
-       atom_quadruplet, &
-       index1, index2, index3, index4, &
-       test_index1, test_index2, test_index3, &
-       interaction_indices, &
-       separations, directions, distances, &
-       calculation_type,energy,forces,enegs,stress, &
-       many_bodies_found)
-    implicit none
-    integer, intent(in) :: calculation_type, n_atoms, index1, index2, index3, index4, &
-         test_index1, test_index2, test_index3
-    integer, pointer :: interaction_indices(:)
-    double precision, intent(out) :: energy, forces(3,n_atoms), enegs(n_atoms), stress(6)
-    double precision, intent(in) :: separations(3,3), directions(3,3), distances(3)
-    logical, intent(out) :: many_bodies_found
-    type(atom), intent(in) :: atom_quadruplet(4)
 
-    type(atom) :: atom1, atom2, atom3, atom4
-    integer :: k, n_targets
-    type(potential) :: interaction
-    double precision :: bo_factors(n_atoms), bo_sums(n_atoms), bo_gradients(3,n_atoms,4), &
-         tmp_energy, tmp_forces(3,4), tmp_enegs(4), &
-         cut_factors(3), cut_gradients(3,3), quad_forces(3,4), bo_virial(6,4)
-    logical :: is_active
+! !!!: list_interactions
+
+  ! Prints some information on the potentials stored in the core in stdout.
+  subroutine list_interactions()
+    implicit none
+    integer :: i, j
+    
+    write(*,*) "interactions"
+    do i = 1, n_interactions
+       write(*,'(A,I5,F10.4)') "type, cutoff ", interactions(i)%type_index, interactions(i)%cutoff
+       write(*,*) "params ", interactions(i)%parameters
+       if(interactions(i)%filter_elements)then
+          write(*,*) "         symbols ", interactions(i)%apply_elements
+          write(*,*) "original symbols ", interactions(i)%original_elements
+       end if
+       if(interactions(i)%filter_tags)then
+          write(*,*) "         tags ", interactions(i)%apply_tags
+          write(*,*) "original tags ", interactions(i)%original_tags
+       end if
+       if(interactions(i)%filter_indices)then
+          write(*,*) "         indices ", interactions(i)%apply_indices
+          write(*,*) "original indices ", interactions(i)%original_indices
+       end if
+       if(interactions(i)%pot_index >= 0)then
+          write(*,*) "bond order index ", interactions(i)%pot_index
+       end if
+       if(size(interactions(i)%multipliers) > 0)then
+          do j = 1, size(interactions(i)%multipliers)
+             write(*,*) "      multiplier ", interactions(i)%multipliers(j)%type_index, &
+                  interactions(i)%multipliers(j)%parameters
+          end do
+       end if
+       write(*,*) ""
+    end do
 
+  end subroutine list_interactions
 
-    many_bodies_found = .false.
-    atom1 = atom_quadruplet(1)
-    atom2 = atom_quadruplet(2)
-    atom3 = atom_quadruplet(3)
-    atom4 = atom_quadruplet(3)
 
-    ! loop over the potentials affecting atom1
-    do k = 1, size(interaction_indices)
+! !!!: list_bonds
 
-       interaction = interactions(interaction_indices(k))
-       call get_number_of_targets_of_potential_index(interaction%type_index,&
-            n_targets) ! in Potentials.f90
-       call potential_affects_atom(interaction,atom_quadruplet(test_index1),is_active,2) ! in Potentials.f90
+  ! Prints some information on the bond order factors stored in the core in stdout.
+  subroutine list_bonds()
+    implicit none
+    integer :: i,j
 
-       ! filter the potentials by:
-       ! is atom2 affected by the potential,
-       ! is atom3 affected by the potential,
-       ! is atom4 affected by the potential,
-       ! is it a 4-body potential
-       if( is_active .and. n_targets == 4 .and. interaction%cutoff > distances(1) )then
-          call potential_affects_atom(interaction,atom_quadruplet(test_index2),is_active,3)  ! in Potentials.f90
-          if( is_active )then
-             call potential_affects_atom(interaction,atom_quadruplet(test_index3),is_active,4)  ! in Potentials.f90
-             if( is_active )then
-                if( interaction%cutoff > distances(2) .and. interaction%cutoff > distances(3) )then
+    write(*,*) "bond order factors"
+    do i = 1, n_bond_factors
+       write(*,'(A,I5,F10.4)') "type, cutoff ", bond_factors(i)%type_index, bond_factors(i)%cutoff
+       write(*,*) "params "
+       do j = 1, size(bond_factors(i)%n_params)
+          write(*,*) j, " : ", bond_factors(i)%parameters(:,j)
+       end do
+       write(*,*) "symbols ",bond_factors(i)%apply_elements
+       write(*,*) "bond order index ", bond_factors(i)%group_index
+    end do
 
-                   ! differentiate between energy, force, and electronegativity evaluation
-                   select case(calculation_type)
-                   case(energy_evaluation_index)
+  end subroutine list_bonds
 
-                      !***************!
-                      ! 4-body energy !
-                      !***************!
+  ! Debug routine for Ewald
+  subroutine core_get_ewald_energy(real_cut, k_cut, reciprocal_cut, sigma, epsilon, energy)
+    implicit none
+    double precision, intent(in) :: real_cut, k_cut, sigma, epsilon
+    integer, intent(in) :: reciprocal_cut(3)
+    double precision, intent(out) :: energy
+    double precision :: scaler(size(atoms))
 
-                      ! If there is a bond order factor associated with the potential,
-                      ! we add the contribution is brings:
-                      !
-                      ! V = \sum_ijkl b_ijkl v_ijkl
-                      ! b_ijkl = (b_i + b_j + b_k + b_l) / 4
-                      if(interaction%pot_index > -1)then
-                         ! get b_i (for all i, they have been precalculated)
-                         call core_get_bond_order_factors(interaction%pot_index,&
-                              bo_factors)
-                      else
-                         bo_factors = 1.d0
-                      end if
+    scaler = 1.d0
 
-                      ! If a smooth cutoff is present, we add the
-                      ! contribution it brings:
-                      ! 
-                      ! V = \sum_ijkl v_ijkl f(r_ij) f(r_jk) f(r_kl)
-                      if(interaction%smoothened)then
-                         ! get f(r_ij)
-                         call smoothening_factor(distances(1),&
-                              interaction%cutoff,interaction%soft_cutoff,&
-                              cut_factors(1))
-                         ! get f(r_jk)
-                         call smoothening_factor(distances(2),&
-                              interaction%cutoff,interaction%soft_cutoff,&
-                              cut_factors(2))
-                         ! get f(r_kl)
-                         call smoothening_factor(distances(3),&
-                              interaction%cutoff,interaction%soft_cutoff,&
-                              cut_factors(3))
-                      else
-                         cut_factors(1:3) = 1.d0
-                      end if
+    call calculate_ewald_energy(atoms,cell,real_cut,k_cut,reciprocal_cut,sigma,&
+         epsilon,scaler,.true.,energy)
 
-                      ! evaluate the 4-body energy
-                      call evaluate_energy(4,interaction%n_product,separations(1:3,1:3),distances(1:3),&
-                           interaction,tmp_energy,atom_quadruplet)
+  end subroutine core_get_ewald_energy
 
-                      ! add the term: b_ijkl v_ijkl f(r_ij) f(r_jk) f(r_lk)
-                      energy = energy + tmp_energy*cut_factors(1)*cut_factors(2)*cut_factors(3)*&
-                           (bo_factors(index1)+bo_factors(index2)+bo_factors(index3)+bo_factors(index3))/4.d0
 
-                   case(force_evaluation_index)
 
-                      !**************!
-                      ! 4-body force !
-                      !**************!
+  ! Sets the parameters for Ewald summation in the core. 
+  !
+  ! *real_cut the real-space cutoff
+  ! *k_radius the k-space cutoff (in inverse length)
+  ! *reciprocal_cut the k-space cutoffs (in numbers of k-space cells)
+  ! *sigma the split parameter
+  ! *epsilon electric constant
+  ! *scaler scaling factors for the individual charges
+  subroutine core_set_ewald_parameters(real_cut, k_radius, reciprocal_cut, sigma, epsilon, scaler)
+    implicit none
+    double precision, intent(in) :: real_cut, k_radius, sigma, epsilon, scaler(:)
+    integer, intent(in) :: reciprocal_cut(3)
+    integer :: i
 
-                      ! We will need the energy contribution 
-                      ! if smooth cutoffs or bond factors are used,
-                      ! since we are mulplying the potential.
-                      if((interaction%pot_index > -1) .or. &
-                           interaction%smoothened)then
-                         call evaluate_energy(4,interaction%n_product,separations(1:3,1:3),distances(1:3),&
-                              interaction,tmp_energy,atom_quadruplet) ! in Potentials.f90
-                      else
-                         tmp_energy = 0.d0
-                      end if
+    evaluate_ewald = .true.
+    evaluate_pme = .false.
+    ewald_k_cutoffs = reciprocal_cut
+    ewald_k_radius = k_radius
+    ewald_cutoff = real_cut
+    ewald_sigma = sigma
+    ewald_epsilon = epsilon
+    if(ewald_allocated)then
+       deallocate(ewald_scaler)
+    else
+       nullify(ewald_scaler)
+    end if
+    allocate(ewald_scaler(size(atoms)))
+    ! the scalers are given in the order of atom indices
+    do i = 1, size(atoms)
+       ewald_scaler(i) = scaler(atoms(i)%index)
+    end do
+    ewald_allocated = .true.
+    
+    call deallocate_ewald_arrays()
+    call allocate_ewald_arrays(size(atoms))
 
-                      ! If a smooth cutoff is present, we add the
-                      ! contribution it brings:
-                      ! 
-                      ! V = \sum_ijkl v_ijkl f(r_ij) f(r_jk) f(r_kl)
-                      ! F_a = - \nabla_a V 
-                      !     = - \sum_ijkl ( v_ijkl f'(r_ij) f(r_jk) f(r_kl) (\nabla_a r_ij) + 
-                      !                   v_ijkl f(r_ij) f'(r_jk) f(r_kl) (\nabla_a r_jk) + 
-                      !                   v_ijkl f(r_ij) f(r_jk) f'(r_kl) (\nabla_a r_kl) +
-                      !                   (\nabla_a v_ijkl) f(r_ij) f(r_jk) f(r_kl) )
-                      !
-                      if(interaction%smoothened)then
-                         ! get f(r_ij)
-                         call smoothening_factor(distances(1),&
-                              interaction%cutoff,interaction%soft_cutoff,&
-                              cut_factors(1)) ! in Potentials.f90
-                         ! get f'(r_ij) (\nabla_a r_ij)
-                         call smoothening_gradient(directions(1:3,1),distances(1),&
-                              interaction%cutoff,interaction%soft_cutoff,&
-                              cut_gradients(1:3,1)) ! in Potentials.f90 
-                         ! get f(r_jk)
-                         call smoothening_factor(distances(2),&
-                              interaction%cutoff,interaction%soft_cutoff,&
-                              cut_factors(2)) ! in Potentials.f90
-                         ! get f'(r_jk) (\nabla_a r_ik)
-                         call smoothening_gradient(directions(1:3,2),distances(2),&
-                              interaction%cutoff,interaction%soft_cutoff,&
-                              cut_gradients(1:3,2)) ! in Potentials.f90
-                         ! get f(r_kl)
-                         call smoothening_factor(distances(3),&
-                              interaction%cutoff,interaction%soft_cutoff,&
-                              cut_factors(3)) ! in Potentials.f90
-                         ! get f'(r_kl) (\nabla_a r_kl)
-                         call smoothening_gradient(directions(1:3,3),distances(3),&
-                              interaction%cutoff,interaction%soft_cutoff,&
-                              cut_gradients(1:3,3)) ! in Potentials.f90
-                      else
-                         cut_factors(1:3) = 1.d0
-                         cut_gradients(1:3,1:3) = 0.d0
-                      end if
+  end subroutine core_set_ewald_parameters
 
 
-                      ! If there is a bond order factor associated with the potential,
-                      ! we add the contribution is brings:
-                      !
-                      ! V = \sum_ijkl b_ijkl v_ijkl
-                      ! b_ijkl = (b_i + b_j + b_k + b_l) / 4
-                      ! F_a = - \nabla_a V 
-                      !     = - \sum_ijkl (\nabla_a b_ijkl) v_ijkl + b_ijkl (\nabla_a v_ijkl)
-                      !     = - \sum_ijkl (\nabla_a b_ijkl) v_ijkl + b_ijkl f_a,ijkl
-                      !
-                      if(interaction%pot_index > -1)then
-                         ! get b_i (for all i, they have been precalculated)
-                         call core_get_bond_order_factors(interaction%pot_index,&
-                              bo_factors) ! in Potentials.f90
-                         ! get (\nabla_a b_i) (for all a)
-                         call core_get_bond_order_gradients(interaction%pot_index,&
-                              index1,& ! atom index
-                              1, & ! slot_index
-                              bo_gradients(1:3,1:n_atoms,1), &
-                              bo_virial(1:6,1)) ! in Potentials.f90
-                         ! get (\nabla_a b_j) (for all a)
-                         call core_get_bond_order_gradients(interaction%pot_index,&
-                              index2,& ! atom index
-                              2, & ! slot_index
-                              bo_gradients(1:3,1:n_atoms,2), &
-                              bo_virial(1:6,2)) ! in Potentials.f90
-                         ! get (\nabla_a b_k) (for all a)
-                         call core_get_bond_order_gradients(interaction%pot_index,&
-                              index3,& ! atom index
-                              3, & ! slot_index
-                              bo_gradients(1:3,1:n_atoms,3), &
-                              bo_virial(1:6,3)) ! in Potentials.f90
-                         ! get (\nabla_a b_l) (for all a)
-                         call core_get_bond_order_gradients(interaction%pot_index,&
-                              index4,& ! atom index
-                              4, & ! slot_index
-                              bo_gradients(1:3,1:n_atoms,4), &
-                              bo_virial(1:6,4)) ! in Potentials.f90
+  ! Sets the parameters for particle mesh Ewald summation in the core. 
+  !
+  ! The real space part and the correction terms are evaluated as in 
+  ! Ewald summation, but the reciprocal space sum is evaluated on a grid.
+  !
+  ! *real_cut the real-space cutoff
+  ! *grid the number of grid points along each cell vector
+  ! *order the order of the B-splines used for interpolating the charges on the grid
+  ! *sigma the split parameter
+  ! *epsilon electric constant
+  ! *scaler scaling factors for the individual charges
+  subroutine core_set_pme_parameters(real_cut, grid, order, sigma, epsilon, scaler)
+    implicit none
+    double precision, intent(in) :: real_cut, sigma, epsilon, scaler(:)
+    integer, intent(in) :: grid(3), order
 
-                         ! Add the bond order gradient terms involving the 
-                         ! atom2-atom1-atom3 energy for all atoms.
-                         ! That is, add the (\nabla_a b_ijk) v_ijk term with 
-                         ! the given ijk (atom2,atom1,atom3) for all a.
-                         forces(1:3,1:n_atoms) = forces(1:3,1:n_atoms) &
-                              - tmp_energy*cut_factors(1)*cut_factors(2)*cut_factors(3)* &
-                              ( bo_gradients(1:3,1:n_atoms,1) &
-                              + bo_gradients(1:3,1:n_atoms,2) &
-                              + bo_gradients(1:3,1:n_atoms,3) &
-                              + bo_gradients(1:3,1:n_atoms,4) )/4.d0
+    call core_set_ewald_parameters(real_cut, 0.d0, (/ 0, 0, 0 /), sigma, epsilon, scaler)
+    evaluate_pme = .true.
+    pme_grid = grid
+    pme_order = order
 
-                         stress(1:6) = stress(1:6) - tmp_energy*cut_factors(1)*cut_factors(2)*cut_factors(3)* &
-                              ( bo_virial(1:6,1) &
-                              + bo_virial(1:6,2) &
-                              + bo_virial(1:6,3) &
-                              + bo_virial(1:6,4) )/4.d0
+  end subroutine core_set_pme_parameters
 
-                      else
-                         bo_factors = 1.d0
-                         bo_sums = 0.d0
-                         bo_gradients = 0.d0
-                      end if
 
+  ! Sets the number of threads used in the evaluation of local interactions.
+  !
+  ! If the core has not been compiled with OpenMP support, the evaluation is
+  ! always serial and the number of threads remains 1.
+  !
+  ! called from PyInterface: :func:`set_number_of_threads`
+  !
+  ! *n_thr the requested number of threads
+  subroutine core_set_number_of_threads(n_thr)
+    implicit none
+    integer, intent(in) :: n_thr
 
-                      ! evaluate the 4-body force
-                      call evaluate_forces(4,interaction%n_product,separations(1:3,1:3),distances(1:3),interaction,&
-                           tmp_forces(1:3,1:4),atom_quadruplet) ! in Potentials.f90
+    n_threads = 1
+!$  n_threads = max(n_thr,1)
 
-                      ! force on atom 1:
-                      quad_forces(1:3,1) = ( tmp_forces(1:3,1)*cut_factors(1)*cut_factors(2)*cut_factors(3) + &
-                           cut_gradients(1:3,1)*cut_factors(2)*cut_factors(3)*tmp_energy ) * &
-                           ( bo_factors(index1) &
-                           + bo_factors(index2) &
-                           + bo_factors(index3) &
-                           + bo_factors(index4) )/4.d0
+  end subroutine core_set_number_of_threads
 
-                      ! force on atom 2:
-                      quad_forces(1:3,2) = ( tmp_forces(1:3,2)*cut_factors(1)*cut_factors(2)*cut_factors(3) + &
-                           (-cut_gradients(1:3,1)*cut_factors(2)*cut_factors(3) + &
-                           cut_gradients(1:3,2)*cut_factors(1)*cut_factors(3)) * tmp_energy ) * &
-                           ( bo_factors(index1) &
-                           + bo_factors(index2) &
-                           + bo_factors(index3) &
-                           + bo_factors(index4) )/4.d0
 
-                      ! force on atom 3:
-                      quad_forces(1:3,3) = ( tmp_forces(1:3,3)*cut_factors(1)*cut_factors(2)*cut_factors(3) + &
-                           (cut_gradients(1:3,3)*cut_factors(1)*cut_factors(2) - &
-                           cut_gradients(1:3,2)*cut_factors(1)*cut_factors(3)) * tmp_energy ) * &
-                           ( bo_factors(index1) &
-                           + bo_factors(index2) &
-                           + bo_factors(index3) &
-                           + bo_factors(index4) )/4.d0
+  ! Returns the number of threads used in the evaluation of local interactions.
+  !
+  ! called from PyInterface: :func:`get_number_of_threads`
+  !
+  ! *n_thr the number of threads
+  subroutine core_get_number_of_threads(n_thr)
+    implicit none
+    integer, intent(out) :: n_thr
 
-                      ! force on atom 4:
-                      quad_forces(1:3,4) = ( tmp_forces(1:3,4)*cut_factors(1)*cut_factors(2)*cut_factors(3) - &
-                           cut_gradients(1:3,3)*cut_factors(1)*cut_factors(2)*tmp_energy ) * &
-                           ( bo_factors(index1) &
-                           + bo_factors(index2) &
-                           + bo_factors(index3) &
-                           + bo_factors(index4) )/4.d0
+    n_thr = n_threads
 
-                      forces(1:3,index1) = forces(1:3,index1) + quad_forces(1:3,1)
-                      forces(1:3,index2) = forces(1:3,index2) + quad_forces(1:3,2)
-                      forces(1:3,index3) = forces(1:3,index3) + quad_forces(1:3,3)
-                      forces(1:3,index4) = forces(1:3,index4) + quad_forces(1:3,4)
-                        
-                   !***************!
-                   ! stress tensor !
-                   !***************!
-                   
-                   ! s_xx, s_yy, s_zz, s_yz, s_xz, s_xy:
-                   stress(1) = stress(1) + separations(1,1) * quad_forces(1,2) &
-                        + (separations(1,1) + separations(1,2)) * quad_forces(1,3) &
-                        + (separations(1,1) + separations(1,2) + separations(1,3)) * quad_forces(1,4)
-                   stress(2) = stress(2) + separations(2,1) * quad_forces(2,2) &
-                        + (separations(2,1) + separations(2,2)) * quad_forces(2,3) &
-                        + (separations(2,1) + separations(2,2) + separations(2,3)) * quad_forces(2,4)
-                   stress(3) = stress(3) + separations(3,1) * quad_forces(3,2) &
-                        + (separations(3,1) + separations(3,2)) * quad_forces(3,3) &
-                        + (separations(3,1) + separations(3,2) + separations(3,3)) * quad_forces(3,4)
-                   stress(4) = stress(4) + separations(2,1) * quad_forces(3,2) &
-                        + (separations(2,1) + separations(2,2)) * quad_forces(3,3) &
-                        + (separations(2,1) + separations(2,2) + separations(2,3)) * quad_forces(3,4)
-                   stress(5) = stress(5) + separations(1,1) * quad_forces(3,2) &
-                        + (separations(1,1) + separations(1,2)) * quad_forces(3,3) &
-                        + (separations(1,1) + separations(1,2) + separations(1,3)) * quad_forces(3,4)
-                   stress(6) = stress(6) + separations(1,1) * quad_forces(2,2) &
-                        + (separations(1,1) + separations(1,2)) * quad_forces(2,3) &
-                        + (separations(1,1) + separations(1,2) + separations(1,3)) * quad_forces(2,4)
+  end subroutine core_get_number_of_threads
 
 
-                   case(electronegativity_evaluation_index)
+  ! Switches the spatial ordering of atoms in the core on or off.
+  ! If switched on, the atoms are reordered by :func:`core_order_atoms_along_curve` 
+  ! the next time the neighbor lists are built.
+  ! Switching the ordering off does not restore the original order, but
+  ! the atoms are no longer reordered.
+  !
+  ! called from PyInterface: :func:`set_spatial_ordering`
+  !
+  ! *ordered true if the atoms should be ordered spatially
+  subroutine core_set_spatial_ordering(ordered)
+    implicit none
+    logical, intent(in) :: ordered
 
-                      !**************************!
-                      ! 4-body electronegativity !
-                      !**************************!
+    spatial_ordering = ordered
 
-                      ! If a smooth cutoff is present, we add the
-                      ! contribution it brings:
-                      if(interaction%smoothened)then
-                         ! get f(r_ij)
-                         call smoothening_factor(distances(1),&
-                              interaction%cutoff,interaction%soft_cutoff,&
-                              cut_factors(1)) ! in Potentials.f90
-                         ! get f(r_jk)
-                         call smoothening_factor(distances(2),&
-                              interaction%cutoff,interaction%soft_cutoff,&
-                              cut_factors(2)) ! in Potentials.f90
-                         ! get f(r_kl)
-                         call smoothening_factor(distances(3),&
-                              interaction%cutoff,interaction%soft_cutoff,&
-                              cut_factors(3)) ! in Potentials.f90
-                      else
-                         cut_factors(1:2) = 1.d0
-                      end if
+  end subroutine core_set_spatial_ordering
 
-                      ! If there is a bond order factor associated with the potential,
-                      ! we add the contribution is brings:
-                      if(interaction%pot_index > -1)then
-                         ! get b_i (for all i, they have been precalculated)
-                         call core_get_bond_order_factors(interaction%pot_index,&
-                              bo_factors) ! in Potentials.f90
-                      else
-                         bo_factors = 1.d0
-                      end if
 
-                      ! evaluate the 4-body e-neg
-                      call evaluate_electronegativity(4,interaction%n_product,separations(1:3,1:3),&
-                           distances(1:3),interaction,&
-                           tmp_enegs(1:4),atom_quadruplet) ! in Potentials.f90
+  ! Tells if the spatial ordering of atoms is switched on.
+  !
+  ! called from PyInterface: :func:`get_spatial_ordering`
+  !
+  ! *ordered true if the atoms are ordered spatially
+  subroutine core_get_spatial_ordering(ordered)
+    implicit none
+    logical, intent(out) :: ordered
 
+    ordered = spatial_ordering
 
-                      ! e-neg on atom 1:
-                      enegs(index1) = enegs(index1) + &
-                           ( tmp_enegs(1)*cut_factors(1)*cut_factors(2)*cut_factors(3) ) * &
-                           ( bo_factors(index1) &
-                           + bo_factors(index2) &
-                           + bo_factors(index3) &
-                           + bo_factors(index4) )/4.d0
+  end subroutine core_get_spatial_ordering
 
-                      ! e-neg on atom 2:
-                      enegs(index2) = enegs(index2) + &
-                           ( tmp_enegs(2)*cut_factors(1)*cut_factors(2)*cut_factors(3) ) * &
-                           ( bo_factors(index1) &
-                           + bo_factors(index2) &
-                           + bo_factors(index3) &
-                           + bo_factors(index4) )/4.d0
 
-                      ! e-neg on atom 3:
-                      enegs(index3) = enegs(index3) + &
-                           ( tmp_enegs(3)*cut_factors(1)*cut_factors(2)*cut_factors(3) ) * &
-                           ( bo_factors(index1) &
-                           + bo_factors(index2) &
-                           + bo_factors(index3) &
-                           + bo_factors(index4) )/4.d0
+  ! Reorders the atoms stored in the core along a space-filling curve.
+  !
+  ! The atoms are sorted according to the Morton keys (see :func:`subcell_morton_key`)
+  ! of the subcells containing them, so atoms in the same subcell become
+  ! contiguous in memory and neighboring subcells are mostly stored close 
+  ! to each other. Since the neighbors of an atom are found in the adjacent 
+  ! subcells, the loops over atoms and their neighbors then access memory 
+  ! much more locally than if the atoms were stored in an arbitrary order.
+  ! The sort is a stable radix sort, so atoms that are already in order are not moved.
+  !
+  ! The atoms keep their original indices in :data:`atom`, which are used
+  ! for identifying the atoms in potentials and when data is passed
+  ! between the core and Python (see :func:`core_restore_atom_order_of_vectors`).
+  ! Since the neighbor lists store the positions of the neighbors in the 
+  ! array of atoms, the lists must be rebuilt after the atoms have been 
+  ! reordered. This routine is only called from :func:`core_create_space_partitioning`
+  ! which is always followed by :func:`core_build_neighbor_lists`.
+  subroutine core_order_atoms_along_curve()
+    implicit none
+    integer, parameter :: radix_bits = 11
+    integer :: n_atoms, n_bits, n_passes, pass, i, bucket
+    integer(kind=8), allocatable :: keys(:)
+    integer, allocatable :: order(:), sorted(:), counts(:), new_position(:)
+    double precision, allocatable :: tmp_positions(:,:), tmp_scaler(:)
+    type(atom), allocatable :: tmp_atoms(:)
+    logical :: moved
 
-                   end select
+    n_atoms = size(atoms)
 
-                end if
-             end if
+    n_bits = 1
+    do while(2**n_bits < maxval(cell%n_splits)+2 .and. n_bits < 21)
+       n_bits = n_bits + 1
+    end do
+    n_passes = (3*n_bits + radix_bits-1) / radix_bits
+
+    allocate(keys(n_atoms))
+    allocate(order(n_atoms))
+    allocate(sorted(n_atoms))
+    allocate(counts(0:2**radix_bits))
+    do i = 1, n_atoms
+       keys(i) = subcell_morton_key(atoms(i)%subcell_indices,n_bits) ! in Geometry.f90
+       order(i) = i
+    end do
+
+    ! radix sort of the keys, from the least significant digit to the most
+    do pass = 1, n_passes
+       counts = 0
+       do i = 1, n_atoms
+          bucket = int(ibits(keys(order(i)),(pass-1)*radix_bits,radix_bits))
+          counts(bucket+1) = counts(bucket+1) + 1
+       end do
+       do bucket = 1, 2**radix_bits
+          counts(bucket) = counts(bucket) + counts(bucket-1)
+       end do
+       do i = 1, n_atoms
+          bucket = int(ibits(keys(order(i)),(pass-1)*radix_bits,radix_bits))
+          counts(bucket) = counts(bucket) + 1
+          sorted(counts(bucket)) = order(i)
+       end do
+       order = sorted
+    end do
+
+    moved = .false.
+    do i = 1, n_atoms
+       if(order(i) /= i)then
+          moved = .true.
+          exit
+       end if
+    end do
+
+    if(moved)then
+
+       ! The atoms are copied as such, so the pointers to their 
+       ! neighbor lists and potential lists move with them.
+       allocate(tmp_atoms(n_atoms))
+       allocate(new_position(n_atoms))
+       do i = 1, n_atoms
+          tmp_atoms(i) = atoms(order(i))
+          new_position(order(i)) = i
+       end do
+       atoms(1:n_atoms) = tmp_atoms(1:n_atoms)
+       deallocate(tmp_atoms)
+
+       do i = 1, n_atoms
+          atom_storage_index(atoms(i)%index) = i
+       end do
+       do i = 1, size(cell%subcell_atoms)
+          cell%subcell_atoms(i) = new_position(cell%subcell_atoms(i))
+       end do
 
+       ! per-atom data stored in the core
+       if(allocated(neighbor_reference_positions))then
+          if(size(neighbor_reference_positions(1,:)) == n_atoms)then
+             allocate(tmp_positions(3,n_atoms))
+             tmp_positions = neighbor_reference_positions
+             do i = 1, n_atoms
+                neighbor_reference_positions(1:3,i) = tmp_positions(1:3,order(i))
+             end do
+             deallocate(tmp_positions)
           end if
        end if
+       if(ewald_allocated)then
+          allocate(tmp_scaler(n_atoms))
+          tmp_scaler = ewald_scaler
+          do i = 1, n_atoms
+             ewald_scaler(i) = tmp_scaler(order(i))
+          end do
+          deallocate(tmp_scaler)
+       end if
+       ! the stored bond order factors refer to the old order
+       call core_empty_bond_order_storage()
+
+       deallocate(new_position)
+
+    end if
+
+    deallocate(keys)
+    deallocate(order)
+    deallocate(sorted)
+    deallocate(counts)
+
+  end subroutine core_order_atoms_along_curve
+
+
+  ! Rearranges an array of vectors, such as forces, calculated for the atoms
+  ! in the order they are stored in the core to the order of atom indices.
+  ! This is needed when the atoms have been reordered by :func:`core_order_atoms_along_curve`.
+  !
+  ! *vectors the vectors, one for each atom
+  subroutine core_restore_atom_order_of_vectors(vectors)
+    implicit none
+    double precision, intent(inout) :: vectors(:,:)
+    double precision, allocatable :: tmp(:,:)
+    integer :: i
+
+    if(.not.atoms_created)then
+       return
+    end if
+    allocate(tmp(size(vectors(:,1)),size(atoms)))
+    tmp = vectors(:,1:size(atoms))
+    do i = 1, size(atoms)
+       vectors(:,atoms(i)%index) = tmp(:,i)
     end do
+    deallocate(tmp)
 
-  end subroutine core_evaluate_local_quadruplet
+  end subroutine core_restore_atom_order_of_vectors
 
 
+  ! Rearranges an array of scalars, such as electronegativities, calculated for 
+  ! the atoms in the order they are stored in the core to the order of atom indices.
+  !
+  ! *values the values, one for each atom
+  subroutine core_restore_atom_order_of_scalars(values)
+    implicit none
+    double precision, intent(inout) :: values(:)
+    double precision, allocatable :: tmp(:)
+    integer :: i
 
+    if(.not.atoms_created)then
+       return
+    end if
+    allocate(tmp(size(atoms)))
+    tmp = values(1:size(atoms))
+    do i = 1, size(atoms)
+       values(atoms(i)%index) = tmp(i)
+    end do
+    deallocate(tmp)
 
+  end subroutine core_restore_atom_order_of_scalars
 
 
+  ! Rearranges an array of logical tags of the atoms in the order
+  ! they are stored in the core to the order of atom indices.
+  !
+  ! *flags the tags, one for each atom
+  subroutine core_restore_atom_order_of_logicals(flags)
+    implicit none
+    logical, intent(inout) :: flags(:)
+    logical, allocatable :: tmp(:)
+    integer :: i
 
-  ! Evaluates the interactions affecting four atoms. (Rearranged internally.)
+    if(.not.atoms_created)then
+       return
+    end if
+    allocate(tmp(size(atoms)))
+    tmp = flags(1:size(atoms))
+    do i = 1, size(atoms)
+       flags(atoms(i)%index) = tmp(i)
+    end do
+    deallocate(tmp)
+
+  end subroutine core_restore_atom_order_of_logicals
+
+
+  ! Converts positions of atoms in the array of atoms stored in the core,
+  ! such as the ones stored in the neighbor lists, to atom indices.
   !
-  ! *n_atoms total number of atoms in the system
-  ! *index1 index of the atom 1
-  ! *index2 index of the atom 2
-  ! *index3 index of the atom 3
-  ! *index4 index of the atom 4
-  ! *atom_quadruplet the atoms that are targeted
-  ! *test_index1 if 1, test if the ineraction targets atom1; similarly for 2, 3
-  ! *test_index2 if 1, test if the ineraction targets atom1; similarly for 2, 3
-  ! *test_index3 if 1, test if the ineraction targets atom1; similarly for 2, 3
-  ! *interaction_indices the interactions targeting the given atoms
-  ! *separations distance vector from 1 to 2, 2 to 3 and 3 to 4 as an array
-  ! *directions unit vector from 1 to 2, 2 to 3 and 3 to 4 as an array
-  ! *distances distance from 1 to 2, 2 to 3 and 3 to 4 as an array
-  ! *calculation_type the type of information requested
-  ! *energy calculated energy
-  ! *forces calculated forces
-  ! *stress calculated stress
-  ! *enegs calculated electronegativities
-  ! *many_bodies_found returns true if the loop finds an interaction with 3 or more targets
-  subroutine core_evaluate_local_quadruplet_B(atom_quadruplet, &
-       index1, index2, index3, index4, &
-       test_index1, test_index2, test_index3, &
-       !interaction_indices, &
-       separations, directions, distances, &
-       calculation_type,energy,forces,enegs,stress, &
-       many_bodies_found, &
-       manybody_indices, &
-       n_manybody )
+  ! *indices the positions of atoms in the core, overwritten by the indices of the atoms
+  subroutine core_restore_atom_indices(indices)
+    implicit none
+    integer, intent(inout) :: indices(:)
+    integer :: i
+
+    do i = 1, size(indices)
+       indices(i) = atoms(indices(i))%index
+    end do
+
+  end subroutine core_restore_atom_indices
+
+
+  ! Partitions the simulation volume in subvolumes for fast neighbor searching.
+  ! The subvolumes are also used as the spatial domains for distributing
+  ! the atoms between cpus in MPI, see :func:`core_distribute_domains`.
+  ! If spatial ordering is enabled, the atoms are also reordered
+  ! according to the subvolumes, see :func:`core_order_atoms_along_curve`.
+  !
+  ! *max_cutoff the maximum cutoff radius for neighbor search
+  subroutine core_create_space_partitioning(max_cutoff)
+    implicit none
+    double precision, intent(in) :: max_cutoff
+    integer :: splits(3)
+
+    call get_optimal_splitting(cell,max_cutoff,splits)
+    call divide_cell(cell,splits)
+    call assign_atoms_to_subcells(cell,atoms)
+
+    if(spatial_ordering)then
+       call core_order_atoms_along_curve()
+    end if
+    call core_distribute_domains()
+
+  end subroutine core_create_space_partitioning
+
+
+  ! Returns statistics on the partitioning of the simulation cell
+  ! in subcells and on the latest neighbor list build.
+  !
+  ! called from PyInterface: :func:`get_subcell_statistics`
+  !
+  ! *splits the number of subcells along each cell vector
+  ! *n_subcells the total number of subcells, including the padding subcells
+  ! *n_occupied the number of subcells containing atoms
+  ! *max_atoms the largest number of atoms in a subcell
+  ! *sparse true if only the occupied subcells are stored
+  ! *n_checks the number of atom pairs whose distance was checked in the latest neighbor list build
+  subroutine core_get_subcell_statistics(splits,n_subcells,n_occupied,max_atoms,sparse,n_checks)
     implicit none
-    integer, intent(in) :: calculation_type, index1, index2, index3, index4, &
-         test_index1, test_index2, test_index3, n_manybody
-    !integer, pointer :: interaction_indices(:)
-    integer, pointer :: manybody_indices(:)
-    double precision, intent(inout) :: energy, forces(:,:), enegs(:), stress(6)
-    double precision, intent(in) :: separations(3,3), directions(3,3), distances(3)
-    logical, intent(out) :: many_bodies_found
-    type(atom), intent(in) :: atom_quadruplet(4)
+    integer, intent(out) :: splits(3), n_occupied, max_atoms
+    integer(kind=8), intent(out) :: n_subcells, n_checks
+    logical, intent(out) :: sparse
+    integer :: i
 
-    type(atom) :: atom1, atom2, atom3, atom4
-    integer :: k, n_targets, n_atoms
-    type(potential) :: interaction
-    double precision :: tmp_energy, tmp_forces(3,4), tmp_enegs(4), prefactor, &
-         cut_factors(3), cut_gradients(3,3), quad_forces(3,4), bo_virial(6,4)
-    logical :: is_active
+    splits = cell%n_splits
+    n_subcells = cell%n_subcells
+    n_occupied = cell%n_occupied_subcells
+    sparse = cell%sparse_subcells
+    n_checks = n_neighbor_distance_checks
+    max_atoms = 0
+    do i = 1, n_occupied
+       max_atoms = max(max_atoms, atoms_in_subcell(cell,cell%occupied_subcells(i)))
+    end do
+
+  end subroutine core_get_subcell_statistics
+
+
+  ! Returns the number of layers of subcells around the domain of a cpu
+  ! from which the neighbor lists are needed for evaluating the local interactions.
+  !
+  ! Since the subcells are at least as wide as the cutoff, the neighbors of an atom are
+  ! always in the adjacent subcells. An n-body interaction may contain atoms 
+  ! n-1 subcells away from the domain, and of these, the neighbor lists of atoms
+  ! up to n-2 subcells away are needed for finding the interacting chain.
+  ! Bond order factors require the neighbors of all the atoms in the chain.
+  ! At least one layer is always included.
+  !
+  ! *depth the number of layers of subcells
+  subroutine core_get_halo_depth(depth)
+    implicit none
+    integer, intent(out) :: depth
+    integer :: i
+
+    depth = 1
+    do i = 1, n_interactions
+       depth = max(depth, size(interactions(i)%apply_elements)-1)
+    end do
+    if(n_bond_factors > 0)then
+       depth = depth+1
+    end if
+
+  end subroutine core_get_halo_depth
+
+
+  ! Distributes the atoms between cpus by spatial domains.
+  !
+  ! The occupied subcells created in :func:`core_create_space_partitioning` are ordered
+  ! so that the axis with the most subcells varies slowest, and the ordered subcells
+  ! are distributed in contiguous blocks by :func:`mpi_distribute_domains`. 
+  ! Each cpu therefore gets a compact slab of the simulation cell.
+  ! Then, the atoms in the subcells within :func:`core_get_halo_depth` layers
+  ! of the domain of this cpu are marked as halo atoms, whose neighbor lists
+  ! are needed by this cpu.
+  subroutine core_distribute_domains()
+    implicit none
+    integer :: n_domains, n_atoms, i, j, i_n, j_n, k_n, depth, slot, nbor_slot, &
+         axes(3), indices(3), nbor_indices(3), axis, pass, bucket, n_buckets
+    integer, allocatable :: domain_atoms(:), atom_domains(:), order(:), sorted(:), &
+         counts(:), domain_indices(:,:)
+    logical, allocatable :: halo_slots(:)
+    logical :: inside
 
     n_atoms = size(atoms)
-    many_bodies_found = .false.
-    atom1 = atom_quadruplet(1)
-    atom2 = atom_quadruplet(2)
-    atom3 = atom_quadruplet(3)
-    atom4 = atom_quadruplet(3)
+    n_domains = cell%n_occupied_subcells
+
+    ! order the axes so that the one with the most subcells is the last (slowest)
+    axes = (/ 1, 2, 3 /)
+    axis = maxloc(cell%n_splits,1)
+    axes(axis) = 3
+    axes(3) = axis
+
+    allocate(domain_indices(3,n_domains))
+    allocate(order(n_domains))
+    allocate(sorted(n_domains))
+    do i = 1, n_domains
+       call get_subcell_indices(cell,cell%occupied_subcells(i),domain_indices(1:3,i))
+       order(i) = i
+    end do
 
-    ! loop over the potentials affecting atom1
-    do k = 1, n_manybody !size(interaction_indices)
+    ! radix sort of the occupied subcells, from the fastest to the slowest axis
+    do pass = 1, 3
+       axis = axes(pass)
+       n_buckets = cell%n_splits(axis)+2
+       allocate(counts(0:n_buckets))
+       counts = 0
+       do i = 1, n_domains
+          bucket = domain_indices(axis,order(i))
+          counts(bucket+1) = counts(bucket+1) + 1
+       end do
+       do bucket = 1, n_buckets
+          counts(bucket) = counts(bucket) + counts(bucket-1)
+       end do
+       do i = 1, n_domains
+          bucket = domain_indices(axis,order(i))
+          counts(bucket) = counts(bucket) + 1
+          sorted(counts(bucket)) = order(i)
+       end do
+       order = sorted
+       deallocate(counts)
+    end do
 
-       interaction = interactions(manybody_indices(k))
-       call get_number_of_targets_of_potential_index(interaction%type_index,&
-            n_targets) ! in Potentials.f90
-       call potential_affects_atom(interaction,atom_quadruplet(test_index1),is_active,2) ! in Potentials.f90
+    ! the domain of each occupied subcell and each atom
+    allocate(domain_atoms(n_domains))
+    allocate(atom_domains(n_atoms))
+    do i = 1, n_domains
+       slot = cell%occupied_subcells(order(i))
+       domain_atoms(i) = atoms_in_subcell(cell,slot)
+       do j = cell%subcell_first(slot), cell%subcell_first(slot+1)-1
+          atom_domains(cell%subcell_atoms(j)) = i
+       end do
+    end do
 
-       ! filter the potentials by:
-       ! is atom2 affected by the potential,
-       ! is atom3 affected by the potential,
-       ! is atom4 affected by the potential,
-       ! is it a 4-body potential
-       if( is_active .and. n_targets == 4 .and. interaction%cutoff > distances(1) )then
-          call potential_affects_atom(interaction,atom_quadruplet(test_index2),is_active,3)  ! in Potentials.f90
-          if( is_active )then
-             call potential_affects_atom(interaction,atom_quadruplet(test_index3),is_active,4)  ! in Potentials.f90
-             if( is_active )then
-                if( interaction%cutoff > distances(2) .and. interaction%cutoff > distances(3) )then
+    call mpi_distribute_domains(n_domains,n_atoms,domain_atoms,atom_domains) ! in MPI.f90
 
-                   ! differentiate between energy, force, and electronegativity evaluation
-                   select case(calculation_type)
-                   case(energy_evaluation_index)
+    if(n_cpus > 1)then
 
-                      !***************!
-                      ! 4-body energy !
-                      !***************!
+       call core_get_halo_depth(depth)
+       neighbor_halo_depth = depth
+       allocate(halo_slots(size(cell%subcell_first)-1))
+       halo_slots = .false.
 
-                      ! If there is a bond order factor associated with the potential,
-                      ! we add the contribution is brings:
-                      !
-                      ! V = \sum_ijkl b_ijkl v_ijkl
-                      ! b_ijkl = (b_i + b_j + b_k + b_l) / 4
-                      if(interaction%pot_index > -1)then
-                         ! get b_i (for all i, they have been precalculated)
-                         call core_get_bond_order_factors(interaction%pot_index,&
-                              bo_factors)
-                      else
-                         !bo_factors = 1.d0
-                      end if
+       do i = 1, n_domains
+          if(domain_owners(i) == cpu_id)then
+             indices = domain_indices(1:3,order(i))
 
-                      ! If a smooth cutoff is present, we add the
-                      ! contribution it brings:
-                      ! 
-                      ! V = \sum_ijkl v_ijkl f(r_ij) f(r_jk) f(r_kl)
-                      if(interaction%smoothened)then
-                         ! get f(r_ij)
-                         call smoothening_factor(distances(1),&
-                              interaction%cutoff,interaction%soft_cutoff,&
-                              cut_factors(1))
-                         ! get f(r_jk)
-                         call smoothening_factor(distances(2),&
-                              interaction%cutoff,interaction%soft_cutoff,&
-                              cut_factors(2))
-                         ! get f(r_kl)
-                         call smoothening_factor(distances(3),&
-                              interaction%cutoff,interaction%soft_cutoff,&
-                              cut_factors(3))
-                      else
-                         cut_factors(1:3) = 1.d0
-                      end if
+             ! mark the occupied subcells around this one
+             do k_n = indices(3)-depth, indices(3)+depth
+                do j_n = indices(2)-depth, indices(2)+depth
+                   do i_n = indices(1)-depth, indices(1)+depth
 
-                      ! evaluate the 4-body energy
-                      call evaluate_energy(4,interaction%n_product,separations(1:3,1:3),distances(1:3),&
-                           interaction,tmp_energy,atom_quadruplet)
+                      nbor_indices = (/ i_n, j_n, k_n /)
+                      inside = .true.
+                      do axis = 1, 3
+                         if(cell%periodic(axis))then
+                            nbor_indices(axis) = modulo(nbor_indices(axis)-1, cell%n_splits(axis)) + 1
+                         else if(nbor_indices(axis) < 0 .or. nbor_indices(axis) > cell%n_splits(axis)+1)then
+                            inside = .false.
+                         end if
+                      end do
 
-                      if(interaction%pot_index > -1)then
-                         ! add the term: b_ijkl v_ijkl f(r_ij) f(r_jk) f(r_lk)
-                         energy = energy + tmp_energy*cut_factors(1)*cut_factors(2)*cut_factors(3)*&
-                              (bo_factors(index1)+bo_factors(index2)+bo_factors(index3)+bo_factors(index3))/4.d0
-                      else
-                         energy = energy + tmp_energy*cut_factors(1)*cut_factors(2)*cut_factors(3)
+                      if(inside)then
+                         nbor_slot = subcell_slot(cell,nbor_indices)
+                         if(nbor_slot > 0)then
+                            halo_slots(nbor_slot) = .true.
+                         end if
                       end if
 
+                   end do
+                end do
+             end do
 
-                   case(force_evaluation_index)
+          end if
+       end do
 
-                      !**************!
-                      ! 4-body force !
-                      !**************!
+       do i = 1, n_atoms
+          slot = cell%occupied_subcells(order(atom_domains(i)))
+          is_halo_atom(i) = (halo_slots(slot) .and. .not.is_my_atom(i))
+       end do
 
-                      ! We will need the energy contribution 
-                      ! if smooth cutoffs or bond factors are used,
-                      ! since we are mulplying the potential.
-                      if((interaction%pot_index > -1) .or. &
-                           interaction%smoothened)then
-                         call evaluate_energy(4,interaction%n_product,separations(1:3,1:3),distances(1:3),&
-                              interaction,tmp_energy,atom_quadruplet) ! in Potentials.f90
-                      else
-                         tmp_energy = 0.d0
-                      end if
+       deallocate(halo_slots)
 
-                      ! If a smooth cutoff is present, we add the
-                      ! contribution it brings:
-                      ! 
-                      ! V = \sum_ijkl v_ijkl f(r_ij) f(r_jk) f(r_kl)
-                      ! F_a = - \nabla_a V 
-                      !     = - \sum_ijkl ( v_ijkl f'(r_ij) f(r_jk) f(r_kl) (\nabla_a r_ij) + 
-                      !                   v_ijkl f(r_ij) f'(r_jk) f(r_kl) (\nabla_a r_jk) + 
-                      !                   v_ijkl f(r_ij) f(r_jk) f'(r_kl) (\nabla_a r_kl) +
-                      !                   (\nabla_a v_ijkl) f(r_ij) f(r_jk) f(r_kl) )
-                      !
-                      if(interaction%smoothened)then
-                         ! get f(r_ij)
-                         call smoothening_factor(distances(1),&
-                              interaction%cutoff,interaction%soft_cutoff,&
-                              cut_factors(1)) ! in Potentials.f90
-                         ! get f'(r_ij) (\nabla_a r_ij)
-                         call smoothening_gradient(directions(1:3,1),distances(1),&
-                              interaction%cutoff,interaction%soft_cutoff,&
-                              cut_gradients(1:3,1)) ! in Potentials.f90 
-                         ! get f(r_jk)
-                         call smoothening_factor(distances(2),&
-                              interaction%cutoff,interaction%soft_cutoff,&
-                              cut_factors(2)) ! in Potentials.f90
-                         ! get f'(r_jk) (\nabla_a r_ik)
-                         call smoothening_gradient(directions(1:3,2),distances(2),&
-                              interaction%cutoff,interaction%soft_cutoff,&
-                              cut_gradients(1:3,2)) ! in Potentials.f90
-                         ! get f(r_kl)
-                         call smoothening_factor(distances(3),&
-                              interaction%cutoff,interaction%soft_cutoff,&
-                              cut_factors(3)) ! in Potentials.f90
-                         ! get f'(r_kl) (\nabla_a r_kl)
-                         call smoothening_gradient(directions(1:3,3),distances(3),&
-                              interaction%cutoff,interaction%soft_cutoff,&
-                              cut_gradients(1:3,3)) ! in Potentials.f90
-                      else
-                         cut_factors(1:3) = 1.d0
-                         cut_gradients(1:3,1:3) = 0.d0
-                      end if
+    end if
 
+    deallocate(domain_indices)
+    deallocate(order)
+    deallocate(sorted)
+    deallocate(domain_atoms)
+    deallocate(atom_domains)
 
-                      ! If there is a bond order factor associated with the potential,
-                      ! we add the contribution is brings:
-                      !
-                      ! V = \sum_ijkl b_ijkl v_ijkl
-                      ! b_ijkl = (b_i + b_j + b_k + b_l) / 4
-                      ! F_a = - \nabla_a V 
-                      !     = - \sum_ijkl (\nabla_a b_ijkl) v_ijkl + b_ijkl (\nabla_a v_ijkl)
-                      !     = - \sum_ijkl (\nabla_a b_ijkl) v_ijkl + b_ijkl f_a,ijkl
-                      !
-                      if(interaction%pot_index > -1)then
-                         ! get b_i (for all i, they have been precalculated)
-                         call core_get_bond_order_factors(interaction%pot_index,&
-                              bo_factors) ! in Potentials.f90
+  end subroutine core_distribute_domains
 
-                         prefactor = -tmp_energy*cut_factors(1)*cut_factors(2)*cut_factors(3)*0.25d0
-                         call core_add_bond_order_forces( &
-                              interaction%pot_index, index1, prefactor, &
-                              forces, stress )
-                         call core_add_bond_order_forces( &
-                              interaction%pot_index, index2, prefactor, &
-                              forces, stress )
-                         call core_add_bond_order_forces( &
-                              interaction%pot_index, index3, prefactor, &
-                              forces, stress )
-                         call core_add_bond_order_forces( &
-                              interaction%pot_index, index4, prefactor, &
-                              forces, stress )
 
-!!$                         ! get (\nabla_a b_i) (for all a)
-!!$                         call core_get_bond_order_gradients(interaction%pot_index,&
-!!$                              index1,& ! atom index
-!!$                              1, & ! slot_index
-!!$                              bo_gradients(1:3,1:n_atoms,1), &
-!!$                              bo_virial(1:6,1)) ! in Potentials.f90
-!!$                         ! get (\nabla_a b_j) (for all a)
-!!$                         call core_get_bond_order_gradients(interaction%pot_index,&
-!!$                              index2,& ! atom index
-!!$                              2, & ! slot_index
-!!$                              bo_gradients(1:3,1:n_atoms,2), &
-!!$                              bo_virial(1:6,2)) ! in Potentials.f90
-!!$                         ! get (\nabla_a b_k) (for all a)
-!!$                         call core_get_bond_order_gradients(interaction%pot_index,&
-!!$                              index3,& ! atom index
-!!$                              3, & ! slot_index
-!!$                              bo_gradients(1:3,1:n_atoms,3), &
-!!$                              bo_virial(1:6,3)) ! in Potentials.f90
-!!$                         ! get (\nabla_a b_l) (for all a)
-!!$                         call core_get_bond_order_gradients(interaction%pot_index,&
-!!$                              index4,& ! atom index
-!!$                              4, & ! slot_index
-!!$                              bo_gradients(1:3,1:n_atoms,4), &
-!!$                              bo_virial(1:6,4)) ! in Potentials.f90
-!!$
-!!$                         ! Add the bond order gradient terms involving the 
-!!$                         ! atom2-atom1-atom3 energy for all atoms.
-!!$                         ! That is, add the (\nabla_a b_ijk) v_ijk term with 
-!!$                         ! the given ijk (atom2,atom1,atom3) for all a.
-!!$                         forces(1:3,1:n_atoms) = forces(1:3,1:n_atoms) &
-!!$                              - tmp_energy*cut_factors(1)*cut_factors(2)*cut_factors(3)* &
-!!$                              ( bo_gradients(1:3,1:n_atoms,1) &
-!!$                              + bo_gradients(1:3,1:n_atoms,2) &
-!!$                              + bo_gradients(1:3,1:n_atoms,3) &
-!!$                              + bo_gradients(1:3,1:n_atoms,4) )/4.d0
-!!$
-!!$                         stress(1:6) = stress(1:6) - tmp_energy*cut_factors(1)*cut_factors(2)*cut_factors(3)* &
-!!$                              ( bo_virial(1:6,1) &
-!!$                              + bo_virial(1:6,2) &
-!!$                              + bo_virial(1:6,3) &
-!!$                              + bo_virial(1:6,4) )/4.d0
+  ! Rebuilds the neighbor lists if the potentials have changed so that
+  ! the lists of more halo atoms are needed in MPI than were built 
+  ! by :func:`core_build_neighbor_lists`.
+  ! In serial runs and for packed systems (see :func:`core_build_packed_neighbor_lists`),
+  ! all lists are always built and nothing is done.
+  subroutine core_check_halo_depth()
+    implicit none
+    integer :: depth
+    double precision, allocatable :: cutoffs(:)
+
+    if(n_cpus == 1 .or. .not.neighbor_reference_set .or. .not.allocated(neighbor_list_cutoffs) &
+         .or. neighbor_list_skin < 0.d0 .or. systems_packed)then
+       return
+    end if
+    if(size(neighbor_list_cutoffs) /= size(atoms))then
+       return
+    end if
+
+    call core_get_halo_depth(depth)
+    if(depth > neighbor_halo_depth)then
+       allocate(cutoffs(size(atoms)))
+       cutoffs = neighbor_list_cutoffs
+       call core_create_space_partitioning(maxval(cutoffs))
+       call core_build_neighbor_lists(cutoffs,neighbor_list_skin)
+       deallocate(cutoffs)
+    end if
+
+  end subroutine core_check_halo_depth
+
+  ! Builds the neighbor lists in the core.
+  ! The simulation cell must be partitioned with :func:`core_create_space_partitioning` 
+  ! before this routine can be called.
+  !
+  ! *cutoffs list of cutoffs, atom by atom in the order of atom indices
+  ! *skin the skin width included in the cutoffs
+  subroutine core_build_neighbor_lists(cutoffs,skin)
+    implicit none
+    double precision, intent(in) :: cutoffs(:), skin
+    integer :: cell_indices(3), nbor_cell_indices(3), j, i_n, j_n, k_n, neighbor_offset(3), &
+         atom1_index, atom2_index, neighbor_slot, max_n_nbors=100, &
+         atom1_wrap_offset(3), atom2_wrap_offset(3), n_atoms
+    integer, pointer, save ::  nbors_and_offsets(:,:,:), n_nbs(:)
+    logical :: neighbor_include, first_run = .true., both_listed
+    double precision :: separation(3), distance, dummy1(3), cutoff1
+    
+    n_atoms = size(atoms) 
+    if(first_run)then
+       nullify(nbors_and_offsets)
+       allocate(nbors_and_offsets(4,max_n_nbors,n_atoms))
+       nullify(n_nbs)
+       allocate(n_nbs(n_atoms))
+       first_run = .false.
+    else if(size(nbors_and_offsets(1,1,:)) /= n_atoms)then
+       deallocate(nbors_and_offsets)
+       allocate(nbors_and_offsets(4,max_n_nbors,n_atoms))
+       deallocate(n_nbs)
+       allocate(n_nbs(n_atoms))
+    end if
 
-                      else
-                         !bo_factors = 1.d0
-                         !bo_sums = 0.d0
-                         !bo_gradients = 0.d0
-                      end if
+    if(allocated(neighbor_list_cutoffs))then
+       deallocate(neighbor_list_cutoffs)
+    end if
+    allocate(neighbor_list_cutoffs(n_atoms))
+    neighbor_list_cutoffs = cutoffs
 
+    n_nbs = 0
 
-                      ! evaluate the 4-body force
-                      call evaluate_forces(4,interaction%n_product,separations(1:3,1:3),distances(1:3),interaction,&
-                           tmp_forces(1:3,1:4),atom_quadruplet) ! in Potentials.f90
+    nbors_and_offsets = 0
+    n_neighbor_distance_checks = 0
 
-                      if(interaction%pot_index > -1)then
-                         ! force on atom 1:
-                         quad_forces(1:3,1) = ( tmp_forces(1:3,1)*cut_factors(1)*cut_factors(2)*cut_factors(3) + &
-                              cut_gradients(1:3,1)*cut_factors(2)*cut_factors(3)*tmp_energy ) * &
-                              ( bo_factors(index1) &
-                              + bo_factors(index2) &
-                              + bo_factors(index3) &
-                              + bo_factors(index4) )/4.d0
-                         
-                         ! force on atom 2:
-                         quad_forces(1:3,2) = ( tmp_forces(1:3,2)*cut_factors(1)*cut_factors(2)*cut_factors(3) + &
-                              (-cut_gradients(1:3,1)*cut_factors(2)*cut_factors(3) + &
-                              cut_gradients(1:3,2)*cut_factors(1)*cut_factors(3)) * tmp_energy ) * &
-                              ( bo_factors(index1) &
-                              + bo_factors(index2) &
-                              + bo_factors(index3) &
-                              + bo_factors(index4) )/4.d0
-                         
-                         ! force on atom 3:
-                         quad_forces(1:3,3) = ( tmp_forces(1:3,3)*cut_factors(1)*cut_factors(2)*cut_factors(3) + &
-                              (cut_gradients(1:3,3)*cut_factors(1)*cut_factors(2) - &
-                              cut_gradients(1:3,2)*cut_factors(1)*cut_factors(3)) * tmp_energy ) * &
-                              ( bo_factors(index1) &
-                              + bo_factors(index2) &
-                              + bo_factors(index3) &
-                              + bo_factors(index4) )/4.d0
-                         
-                         ! force on atom 4:
-                         quad_forces(1:3,4) = ( tmp_forces(1:3,4)*cut_factors(1)*cut_factors(2)*cut_factors(3) - &
-                              cut_gradients(1:3,3)*cut_factors(1)*cut_factors(2)*tmp_energy ) * &
-                              ( bo_factors(index1) &
-                              + bo_factors(index2) &
-                              + bo_factors(index3) &
-                              + bo_factors(index4) )/4.d0
+    ! In MPI, the lists are only built for the atoms of this cpu and
+    ! the halo atoms around them. The other cpus build their own lists.
+    do atom1_index = 1, size(atoms)
 
-                      else
-                         ! force on atom 1:
-                         quad_forces(1:3,1) = ( tmp_forces(1:3,1)*cut_factors(1)*cut_factors(2)*cut_factors(3) + &
-                              cut_gradients(1:3,1)*cut_factors(2)*cut_factors(3)*tmp_energy )
-                         
-                         ! force on atom 2:
-                         quad_forces(1:3,2) = ( tmp_forces(1:3,2)*cut_factors(1)*cut_factors(2)*cut_factors(3) + &
-                              (-cut_gradients(1:3,1)*cut_factors(2)*cut_factors(3) + &
-                              cut_gradients(1:3,2)*cut_factors(1)*cut_factors(3)) * tmp_energy ) 
-                         
-                         ! force on atom 3:
-                         quad_forces(1:3,3) = ( tmp_forces(1:3,3)*cut_factors(1)*cut_factors(2)*cut_factors(3) + &
-                              (cut_gradients(1:3,3)*cut_factors(1)*cut_factors(2) - &
-                              cut_gradients(1:3,2)*cut_factors(1)*cut_factors(3)) * tmp_energy ) 
-                         
-                         ! force on atom 4:
-                         quad_forces(1:3,4) = ( tmp_forces(1:3,4)*cut_factors(1)*cut_factors(2)*cut_factors(3) - &
-                              cut_gradients(1:3,3)*cut_factors(1)*cut_factors(2)*tmp_energy ) 
+       if(is_my_atom(atom1_index) .or. is_halo_atom(atom1_index))then
+          
+          cell_indices = atoms(atom1_index)%subcell_indices
+          cutoff1 = cutoffs(atoms(atom1_index)%index)
+          call wrapped_coordinates(atoms(atom1_index)%position,cell,dummy1,atom1_wrap_offset)
+
+          do k_n = -1,1
+             do j_n = -1,1
+                do i_n = -1,1
+                   
+                   call get_neighbor_subcell(cell,cell_indices,(/ i_n, j_n, k_n /),&
+                        nbor_cell_indices,neighbor_offset,neighbor_include)
 
+                   if(neighbor_include)then
+                      neighbor_slot = subcell_slot(cell,nbor_cell_indices)
+                      if(neighbor_slot == 0)then
+                         cycle
                       end if
+                      
+                      do j = cell%subcell_first(neighbor_slot), cell%subcell_first(neighbor_slot+1)-1
+                         atom2_index = cell%subcell_atoms(j)
+                         call wrapped_coordinates(atoms(atom2_index)%position,cell,dummy1,atom2_wrap_offset)
 
-                      forces(1:3,index1) = forces(1:3,index1) + quad_forces(1:3,1)
-                      forces(1:3,index2) = forces(1:3,index2) + quad_forces(1:3,2)
-                      forces(1:3,index3) = forces(1:3,index3) + quad_forces(1:3,3)
-                      forces(1:3,index4) = forces(1:3,index4) + quad_forces(1:3,4)
-                        
-                   !***************!
-                   ! stress tensor !
-                   !***************!
-                   
-                   ! s_xx, s_yy, s_zz, s_yz, s_xz, s_xy:
-                   stress(1) = stress(1) + separations(1,1) * quad_forces(1,2) &
-                        + (separations(1,1) + separations(1,2)) * quad_forces(1,3) &
-                        + (separations(1,1) + separations(1,2) + separations(1,3)) * quad_forces(1,4)
-                   stress(2) = stress(2) + separations(2,1) * quad_forces(2,2) &
-                        + (separations(2,1) + separations(2,2)) * quad_forces(2,3) &
-                        + (separations(2,1) + separations(2,2) + separations(2,3)) * quad_forces(2,4)
-                   stress(3) = stress(3) + separations(3,1) * quad_forces(3,2) &
-                        + (separations(3,1) + separations(3,2)) * quad_forces(3,3) &
-                        + (separations(3,1) + separations(3,2) + separations(3,3)) * quad_forces(3,4)
-                   stress(4) = stress(4) + separations(2,1) * quad_forces(3,2) &
-                        + (separations(2,1) + separations(2,2)) * quad_forces(3,3) &
-                        + (separations(2,1) + separations(2,2) + separations(2,3)) * quad_forces(3,4)
-                   stress(5) = stress(5) + separations(1,1) * quad_forces(3,2) &
-                        + (separations(1,1) + separations(1,2)) * quad_forces(3,3) &
-                        + (separations(1,1) + separations(1,2) + separations(1,3)) * quad_forces(3,4)
-                   stress(6) = stress(6) + separations(1,1) * quad_forces(2,2) &
-                        + (separations(1,1) + separations(1,2)) * quad_forces(2,3) &
-                        + (separations(1,1) + separations(1,2) + separations(1,3)) * quad_forces(2,4)
+                         ! Prevent double counting. If the list of atom2 is not 
+                         ! built on this cpu, the pair is only stored for atom1.
+                         both_listed = (is_my_atom(atom2_index) .or. is_halo_atom(atom2_index))
+                         if(.not.both_listed .or. pick(atom1_index,atom2_index,neighbor_offset))then
+                            n_neighbor_distance_checks = n_neighbor_distance_checks + 1
+                            call separation_vector(atoms(atom1_index)%position, &
+                                 atoms(atom2_index)%position, &
+                                 neighbor_offset - atom1_wrap_offset + atom2_wrap_offset, &
+                                 cell, &
+                                 separation)
+                            ! distance squared
+                            distance = separation.o.separation
+
+                            ! atom2 is neighbor of atom1
+                            if(distance < cutoff1*cutoff1)then
+                               n_nbs(atom1_index) = n_nbs(atom1_index)+1
+                               nbors_and_offsets(1,n_nbs(atom1_index),atom1_index) = atom2_index
+                               nbors_and_offsets(2:4,n_nbs(atom1_index),atom1_index) = neighbor_offset(1:3) &
+                                     - atom1_wrap_offset(1:3) + atom2_wrap_offset(1:3)
+                               if(n_nbs(atom1_index) == max_n_nbors)then
+                                  call expand_neighbor_storage(nbors_and_offsets,max_n_nbors,max_n_nbors+50,n_atoms)
+                                  max_n_nbors = max_n_nbors + 50
+                               end if
+                            end if
 
+                            ! atom1 is neighbor of atom2
+                            if(both_listed .and. distance < &
+                                 cutoffs(atoms(atom2_index)%index)*cutoffs(atoms(atom2_index)%index))then
+                               n_nbs(atom2_index) = n_nbs(atom2_index)+1
+                               nbors_and_offsets(1,n_nbs(atom2_index),atom2_index) = atom1_index
+                               nbors_and_offsets(2:4,n_nbs(atom2_index),atom2_index) = -neighbor_offset &
+                                     + atom1_wrap_offset(1:3) - atom2_wrap_offset(1:3)
+                               if(n_nbs(atom2_index) == max_n_nbors)then
+                                  call expand_neighbor_storage(nbors_and_offsets,max_n_nbors,max_n_nbors+50,n_atoms)
+                                  max_n_nbors = max_n_nbors + 50
+                               end if
+                            end if
 
-                   case(electronegativity_evaluation_index)
+                         end if ! pick
 
-                      !**************************!
-                      ! 4-body electronegativity !
-                      !**************************!
+                      end do ! j, atoms in the neighboring subcell
+                      
+                   end if
+                   
+                end do
+             end do
+          end do
+          
+          
+       end if ! is_my_atom or is_halo_atom
+    end do ! atom1_index
 
-                      ! If a smooth cutoff is present, we add the
-                      ! contribution it brings:
-                      if(interaction%smoothened)then
-                         ! get f(r_ij)
-                         call smoothening_factor(distances(1),&
-                              interaction%cutoff,interaction%soft_cutoff,&
-                              cut_factors(1)) ! in Potentials.f90
-                         ! get f(r_jk)
-                         call smoothening_factor(distances(2),&
-                              interaction%cutoff,interaction%soft_cutoff,&
-                              cut_factors(2)) ! in Potentials.f90
-                         ! get f(r_kl)
-                         call smoothening_factor(distances(3),&
-                              interaction%cutoff,interaction%soft_cutoff,&
-                              cut_factors(3)) ! in Potentials.f90
-                      else
-                         cut_factors(1:2) = 1.d0
-                      end if
+    do atom1_index = 1, n_atoms
+       call assign_neighbor_list(n_nbs(atom1_index),atoms(atom1_index)%neighbor_list,&
+            nbors_and_offsets(1,1:n_nbs(atom1_index),atom1_index),&
+            nbors_and_offsets(2:4,1:n_nbs(atom1_index),atom1_index)) ! in Geometry.f90
+    end do
+    neighbor_list_skin = skin
 
-                      ! If there is a bond order factor associated with the potential,
-                      ! we add the contribution is brings:
-                      if(interaction%pot_index > -1)then
-                         ! get b_i (for all i, they have been precalculated)
-                         call core_get_bond_order_factors(interaction%pot_index,&
-                              bo_factors) ! in Potentials.f90
-                      else
-                         !bo_factors = 1.d0
-                      end if
+    call core_set_neighbor_reference_positions()
+    call core_divide_neighbor_lists_in_tiers()
 
-                      ! evaluate the 4-body e-neg
-                      call evaluate_electronegativity(4,interaction%n_product,separations(1:3,1:3),&
-                           distances(1:3),interaction,&
-                           tmp_enegs(1:4),atom_quadruplet) ! in Potentials.f90
+  end subroutine core_build_neighbor_lists
 
 
-                      if(interaction%pot_index > -1)then
-                         ! e-neg on atom 1:
-                         enegs(index1) = enegs(index1) + &
-                              ( tmp_enegs(1)*cut_factors(1)*cut_factors(2)*cut_factors(3) ) * &
-                              ( bo_factors(index1) &
-                              + bo_factors(index2) &
-                              + bo_factors(index3) &
-                              + bo_factors(index4) )/4.d0
-                         
-                         ! e-neg on atom 2:
-                         enegs(index2) = enegs(index2) + &
-                              ( tmp_enegs(2)*cut_factors(1)*cut_factors(2)*cut_factors(3) ) * &
-                              ( bo_factors(index1) &
-                              + bo_factors(index2) &
-                              + bo_factors(index3) &
-                              + bo_factors(index4) )/4.d0
-                         
-                         ! e-neg on atom 3:
-                         enegs(index3) = enegs(index3) + &
-                              ( tmp_enegs(3)*cut_factors(1)*cut_factors(2)*cut_factors(3) ) * &
-                              ( bo_factors(index1) &
-                              + bo_factors(index2) &
-                              + bo_factors(index3) &
-                              + bo_factors(index4) )/4.d0
+! !!!: core_build_packed_neighbor_lists
 
-                         ! e-neg on atom 4:
-                         enegs(index4) = enegs(index4) + &
-                              ( tmp_enegs(4)*cut_factors(1)*cut_factors(2)*cut_factors(3) ) * &
-                              ( bo_factors(index1) &
-                              + bo_factors(index2) &
-                              + bo_factors(index3) &
-                              + bo_factors(index4) )/4.d0
-                      else
-                         ! e-neg on atom 1:
-                         enegs(index1) = enegs(index1) + &
-                              ( tmp_enegs(1)*cut_factors(1)*cut_factors(2)*cut_factors(3) )
-                         
-                         ! e-neg on atom 2:
-                         enegs(index2) = enegs(index2) + &
-                              ( tmp_enegs(2)*cut_factors(1)*cut_factors(2)*cut_factors(3) ) 
-                         
-                         ! e-neg on atom 3:
-                         enegs(index3) = enegs(index3) + &
-                              ( tmp_enegs(3)*cut_factors(1)*cut_factors(2)*cut_factors(3) ) 
+  ! Builds the neighbor lists for systems packed in the core with :func:`core_pack_systems`.
+  !
+  ! The neighbors of each atom are searched among the atoms of its own system
+  ! by checking all pairs and all the periodic images within the cutoff.
+  ! The cost thus grows as the square of the size of the systems, but
+  ! unlike :func:`core_build_neighbor_lists`, this works also for small 
+  ! periodic systems where the cutoffs are longer than the cell.
+  ! The packed systems are meant to be small, so this is not a problem.
+  !
+  ! The lists are built without a skin.
+  !
+  ! called from PyInterface: :func:`generate_packed_neighbor_lists`
+  !
+  ! *cutoffs An array containing the cutoff radius for each atom, indexed by atom index.
+  subroutine core_build_packed_neighbor_lists(cutoffs)
+    implicit none
+    double precision, intent(in) :: cutoffs(:)
+    integer :: n_atoms, n_systems, system_index, first, last, index1, index2, &
+         i, j, k, n_nbs, max_n_nbors, images(3), offset(3)
+    integer, allocatable :: system_first(:), wrap_offsets(:,:), &
+         nbors_and_offsets(:,:), temp_storage(:,:)
+    double precision :: separation(3), cutoff1, max_cutoff
+    double precision, allocatable :: wrapped(:,:)
+    type(supercell), pointer :: system_cell
 
-                         ! e-neg on atom 4:
-                         enegs(index4) = enegs(index4) + &
-                              ( tmp_enegs(4)*cut_factors(1)*cut_factors(2)*cut_factors(3) ) 
-                      end if
+    n_atoms = size(atoms)
+    n_systems = size(system_cells)
+
+    if(allocated(neighbor_list_cutoffs))then
+       deallocate(neighbor_list_cutoffs)
+    end if
+    allocate(neighbor_list_cutoffs(n_atoms))
+    neighbor_list_cutoffs = cutoffs
+    n_neighbor_distance_checks = 0
+
+    ! the atoms of each system are stored consecutively
+    allocate(system_first(n_systems+1))
+    system_first = n_atoms+1
+    do index1 = n_atoms, 1, -1
+       system_first(atom_systems(atoms(index1)%index)) = index1
+    end do
+    do system_index = n_systems, 1, -1
+       system_first(system_index) = min(system_first(system_index),system_first(system_index+1))
+    end do
+
+    ! the pairs are searched using positions wrapped in the cells of the systems
+    allocate(wrapped(3,n_atoms))
+    allocate(wrap_offsets(3,n_atoms))
+    do index1 = 1, n_atoms
+       call wrapped_coordinates(atoms(index1)%position,core_cell_of_atom(atoms(index1)%index),&
+            wrapped(1:3,index1),wrap_offsets(1:3,index1)) ! in Geometry.f90
+    end do
 
-                   end select
+    max_n_nbors = 100
+    allocate(nbors_and_offsets(4,max_n_nbors))
 
-                end if
-             end if
+    do system_index = 1, n_systems
+       first = system_first(system_index)
+       last = system_first(system_index+1)-1
+       if(last < first)then
+          cycle
+       end if
+       system_cell => system_cells(system_index)
 
+       ! The wrapped positions are within the cell, so the separations 
+       ! within the cutoff can only reach the given number of images.
+       max_cutoff = 0.d0
+       do index1 = first, last
+          max_cutoff = max(max_cutoff,cutoffs(atoms(index1)%index))
+       end do
+       images = 0
+       do i = 1, 3
+          if(system_cell%periodic(i))then
+             images(i) = ceiling(max_cutoff * (.norm.system_cell%inverse_cell(i,1:3))) + 1
           end if
-       end if
+       end do
+
+       do index1 = first, last
+          n_nbs = 0
+          cutoff1 = cutoffs(atoms(index1)%index)
+          do index2 = first, last
+             do k = -images(3), images(3)
+                do j = -images(2), images(2)
+                   do i = -images(1), images(1)
+                      offset = (/ i, j, k /)
+                      if(index1 == index2 .and. i == 0 .and. j == 0 .and. k == 0)then
+                         cycle
+                      end if
+                      n_neighbor_distance_checks = n_neighbor_distance_checks + 1
+                      call separation_vector(wrapped(1:3,index1), &
+                           wrapped(1:3,index2), &
+                           offset, &
+                           system_cell, &
+                           separation) ! in Geometry.f90
+                      if((separation.o.separation) < cutoff1*cutoff1)then
+                         if(n_nbs == max_n_nbors)then
+                            allocate(temp_storage(4,max_n_nbors))
+                            temp_storage = nbors_and_offsets
+                            deallocate(nbors_and_offsets)
+                            allocate(nbors_and_offsets(4,2*max_n_nbors))
+                            nbors_and_offsets(1:4,1:max_n_nbors) = temp_storage
+                            deallocate(temp_storage)
+                            max_n_nbors = 2*max_n_nbors
+                         end if
+                         n_nbs = n_nbs + 1
+                         nbors_and_offsets(1,n_nbs) = index2
+                         nbors_and_offsets(2:4,n_nbs) = offset(1:3) &
+                              - wrap_offsets(1:3,index1) + wrap_offsets(1:3,index2)
+                      end if
+                   end do
+                end do
+             end do
+          end do
+          call assign_neighbor_list(n_nbs,atoms(index1)%neighbor_list,&
+               nbors_and_offsets(1,1:n_nbs),nbors_and_offsets(2:4,1:n_nbs)) ! in Geometry.f90
+       end do
     end do
 
-  end subroutine core_evaluate_local_quadruplet_B
+    deallocate(nbors_and_offsets)
+    deallocate(wrapped)
+    deallocate(wrap_offsets)
+    deallocate(system_first)
+    neighbor_list_skin = 0.d0
 
+    call core_set_neighbor_reference_positions()
+    call core_divide_neighbor_lists_in_tiers()
 
+  end subroutine core_build_packed_neighbor_lists
 
 
+  ! Stores the current positions of atoms as the reference
+  ! for tracking atomic displacements.
+  ! This is done automatically whenever the neighbor lists
+  ! are built in :func:`core_build_neighbor_lists`.
+  subroutine core_set_neighbor_reference_positions()
+    implicit none
+    integer :: i
 
+    if(allocated(neighbor_reference_positions))then
+       if(size(neighbor_reference_positions(1,:)) /= size(atoms))then
+          deallocate(neighbor_reference_positions)
+       end if
+    end if
+    if(.not.allocated(neighbor_reference_positions))then
+       allocate(neighbor_reference_positions(3,size(atoms)))
+    end if
 
-! !!!: core_calculate_forces
+    do i = 1, size(atoms)
+       neighbor_reference_positions(1:3,i) = atoms(i)%position(1:3)
+    end do
+    neighbor_reference_set = .true.
 
-  ! Calculates forces acting on all atoms of the system.
-  !
-  ! The routine calculates the potential gradient
-  !
-  ! .. math::
-  !
-  !    \mathbf{F}_\alpha = - \nabla_\alpha V
-  !
-  ! for all atoms :math:`\alpha`. This is done according to the
-  ! the structure and potentials allocated in the core, so the
-  ! routine does not accept arguments. Instead, the core modifying
-  ! routines such as :func:`core_generate_atoms` must be called
-  ! first to set up the calculation.
-  !
-  ! called from PyInterface: :func:`calculate_forces`
+  end subroutine core_set_neighbor_reference_positions
+
+
+  ! Divides the neighbor lists of all atoms in tiers according to the
+  ! cutoffs of the potentials and bond order factors of each atom,
+  ! see :func:`divide_neighbor_list_in_tiers`. The loops over neighbors
+  ! in the evaluation of many-body potentials and bond order factors 
+  ! then only visit the neighbors that may be within the cutoffs 
+  ! instead of the whole list, which may be much longer due to 
+  ! for instance the real space cutoff of Ewald summation.
   !
-  ! *total_forces an array containing the calculated forces for all atoms
-  ! *total_stress as array containing the calculated stress tensor
-  subroutine core_calculate_forces(total_forces,total_stress)
+  ! The distances are measured from the positions at the time the lists 
+  ! were built. Nothing is done if the lists have not been built in the core.
+  subroutine core_divide_neighbor_lists_in_tiers()
     implicit none
-    double precision, intent(inout) :: total_forces(:,:), total_stress(6)
-    double precision :: dummy_energy
+    integer :: i
 
-    call core_loop_over_local_interactions(force_evaluation_index,&
-         dummy_energy,total_forces,temp_enegs,total_stress)
+    if(.not.atoms_created .or. .not.neighbor_reference_set .or. neighbor_list_skin < 0.d0)then
+       return
+    end if
+    if(size(neighbor_reference_positions(1,:)) /= size(atoms))then
+       return
+    end if
 
-  end subroutine core_calculate_forces
+    do i = 1, size(atoms)
+       call core_divide_neighbor_list_of_atom_in_tiers(i)
+    end do
 
+  end subroutine core_divide_neighbor_lists_in_tiers
 
 
+  ! Divides the neighbor list of the given atom in tiers as
+  ! :func:`core_divide_neighbor_lists_in_tiers`. This is needed 
+  ! separately when the potentials of a single atom change
+  ! (see :func:`core_swap_atom_species`).
+  !
+  ! *index1 index of the atom
+  subroutine core_divide_neighbor_list_of_atom_in_tiers(index1)
+    implicit none
+    integer, intent(in) :: index1
+    integer :: j, n_nbs
+    double precision :: separation(3), radii(2)
+    double precision, allocatable :: distances(:)
 
+    if(.not.atoms_created .or. .not.neighbor_reference_set .or. neighbor_list_skin < 0.d0)then
+       return
+    end if
 
-! !!!: core_calculate_electronegativities
+    n_nbs = atoms(index1)%neighbor_list%n_neighbors
+    if(n_nbs > 0)then
+       allocate(distances(n_nbs))
+       do j = 1, n_nbs
+          call separation_vector(neighbor_reference_positions(1:3,index1), &
+               neighbor_reference_positions(1:3,atoms(index1)%neighbor_list%neighbors(j)), &
+               atoms(index1)%neighbor_list%pbc_offsets(1:3,j), &
+               core_cell_of_atom(atoms(index1)%index), &
+               separation) ! in Geometry.f90
+          distances(j) = .norm.separation
+       end do
+       radii(1) = atoms(index1)%max_potential_radius
+       radii(2) = atoms(index1)%max_bond_radius
+       call divide_neighbor_list_in_tiers(atoms(index1)%neighbor_list,distances(1:n_nbs),&
+            radii,neighbor_list_skin) ! in Geometry.f90
+       deallocate(distances)
+    end if
 
-  ! Calculates electronegativity forces acting on all atomic charges of the system.
-  !
-  ! The routine calculates the electronegativities
-  !
-  ! .. math::
-  !
-  !    \chi_{\alpha} = -\frac{\partial V}{\partial q_\alpha}
-  !
-  ! for all atoms :math:`\alpha`. This is done according to the
-  ! the structure and potentials allocated in the core, so the
-  ! routine does not accept arguments. Instead, the core modifying
-  ! routines such as :func:`core_generate_atoms` must be called
-  ! first to set up the calculation.
+  end subroutine core_divide_neighbor_list_of_atom_in_tiers
+
+
+  ! Returns the largest distance any atom has moved since
+  ! the neighbor lists were last built.
+  ! If the neighbor lists have been built with a skin, i.e., 
+  ! each atom lists its neighbors within the distance
+  ! :math:`r_\mathrm{cut} + r_\mathrm{skin}`, the lists are guaranteed
+  ! to contain all neighbors within :math:`r_\mathrm{cut}` as long as
+  ! no atom has moved more than :math:`r_\mathrm{skin}/2`.
   !
-  ! called from PyInterface: :func:`calculate_electronegativities`
+  ! If no reference positions are known, a huge number is returned
+  ! so that the lists will be rebuilt.
   !
-  ! *total_enegs an array containing the calculated charge forces for all atoms
-  subroutine core_calculate_electronegativities(total_enegs)
+  ! *max_displacement the maximum displacement
+  subroutine core_get_max_displacement(max_displacement)
     implicit none
-    double precision, intent(inout) :: total_enegs(:)
-    double precision :: dummy_energy, dummy_stress(6)
-
-    call core_loop_over_local_interactions(electronegativity_evaluation_index,&
-         dummy_energy,temp_forces,total_enegs,dummy_stress)
-    return
+    double precision, intent(out) :: max_displacement
+    double precision :: step(3)
+    integer :: i
 
-  end subroutine core_calculate_electronegativities
+    if(.not.neighbor_reference_set)then
+       max_displacement = huge(max_displacement)
+       return
+    end if
 
+    max_displacement = 0.d0
+    do i = 1, size(atoms)
+       step = atoms(i)%position(1:3) - neighbor_reference_positions(1:3,i)
+       max_displacement = max(max_displacement, step.o.step)
+    end do
+    max_displacement = sqrt(max_displacement)
 
+  end subroutine core_get_max_displacement
 
 
-! !!!: core_calculate_energy
+! !!!: core_swap_atom_species
 
-  ! Calculates the total potential energy of the system.
-  !
-  ! This is done according to the
-  ! the structure and potentials allocated in the core, so the
-  ! routine does not accept arguments. Instead, the core modifying
-  ! routines such as :func:`core_generate_atoms` must be called
-  ! first to set up the calculation.
+  ! Exchanges the elements, masses and charges of two atoms.
+  ! The positions, momenta, tags and indices stay in place, so
+  ! this corresponds to the two atoms swapping places.
+  ! The lists of potentials and bond order factors of the two atoms
+  ! are updated, as well as the tiers of their neighbor lists.
   !
-  ! called from PyInterface: :func:`calculate_energy`
+  ! *index1 index of the first atom
+  ! *index2 index of the second atom
+  subroutine core_swap_atom_species(index1,index2)
+    implicit none
+    integer, intent(in) :: index1, index2
+    character(len=label_length) :: element
+    double precision :: mass, charge
+
+    element = atoms(index1)%element
+    mass = atoms(index1)%mass
+    charge = atoms(index1)%charge
+    atoms(index1)%element = atoms(index2)%element
+    atoms(index1)%mass = atoms(index2)%mass
+    atoms(index1)%charge = atoms(index2)%charge
+    atoms(index2)%element = element
+    atoms(index2)%mass = mass
+    atoms(index2)%charge = charge
+
+    call core_assign_potential_indices_of_atom(index1)
+    call core_assign_potential_indices_of_atom(index2)
+    call core_assign_bond_order_factor_indices_of_atom(index1)
+    call core_assign_bond_order_factor_indices_of_atom(index2)
+    call core_divide_neighbor_list_of_atom_in_tiers(index1)
+    call core_divide_neighbor_list_of_atom_in_tiers(index2)
+
+  end subroutine core_swap_atom_species
+
+
+! !!!: core_expand_atom_set
+
+  ! Adds to a set of atoms all the atoms within the given number of
+  ! neighbor hops from the atoms members(first:last).
+  ! On each hop, the neighbors of the atoms reached on the previous hop
+  ! are reached if they are within the given radius plus a tolerance.
+  ! The distances are measured at the current positions, so if an atom
+  ! is about to move, the tolerance must cover the length of the step.
+  ! The search is independent of the atoms already in the set, so
+  ! the set may be expanded several times with different radii.
+  ! Only the tiers of the neighbor lists within the radius are searched
+  ! (see :func:`neighbors_within`), since they contain all the neighbors 
+  ! within the tier radii.
+  !
+  ! *first the first atom from which the search is started
+  ! *last the last atom from which the search is started
+  ! *n_hops the number of hops
+  ! *radius the maximum length of a hop
+  ! *tolerance the amount by which the length of a hop may exceed the radius
+  ! *n_members the number of atoms in the set
+  ! *members the atoms in the set
+  ! *marked logical array, true for the atoms in the set
+  subroutine core_expand_atom_set(first,last,n_hops,radius,tolerance,n_members,members,marked)
+    implicit none
+    integer, intent(in) :: first, last, n_hops
+    double precision, intent(in) :: radius, tolerance
+    integer, intent(inout) :: n_members, members(:)
+    logical, intent(inout) :: marked(:)
+    integer, allocatable, save :: visited(:), reached(:)
+    integer, save :: stamp = 0
+    integer :: hop, i, j, index1, index2, n_reached, hop_first, hop_last
+    double precision :: separation(3)
+
+    ! The atoms reached in this search are marked with a stamp
+    ! so that the marks need not be cleared. The work arrays are kept
+    ! between the calls, so that the cost of the search only depends
+    ! on the number of atoms reached.
+    if(allocated(visited))then
+       if(size(visited) /= size(atoms))then
+          deallocate(visited)
+          deallocate(reached)
+       end if
+    end if
+    if(.not.allocated(visited))then
+       allocate(visited(size(atoms)))
+       allocate(reached(size(atoms)))
+       visited = 0
+       stamp = 0
+    end if
+    stamp = stamp + 1
+
+    n_reached = 0
+    do i = first, last
+       if(visited(members(i)) /= stamp)then
+          visited(members(i)) = stamp
+          n_reached = n_reached + 1
+          reached(n_reached) = members(i)
+       end if
+    end do
+
+    hop_first = 1
+    do hop = 1, n_hops
+       hop_last = n_reached
+       do i = hop_first, hop_last
+          index1 = reached(i)
+          do j = 1, neighbors_within(atoms(index1)%neighbor_list,radius) ! in Geometry.f90
+             index2 = atoms(index1)%neighbor_list%neighbors(j)
+             if(visited(index2) /= stamp)then
+                call separation_vector(atoms(index1)%position, &
+                     atoms(index2)%position, &
+                     atoms(index1)%neighbor_list%pbc_offsets(1:3,j), &
+                     core_cell_of_atom(atoms(index1)%index), &
+                     separation) ! in Geometry.f90
+                if(.norm.separation > radius + tolerance)then
+                   cycle
+                end if
+                visited(index2) = stamp
+                n_reached = n_reached + 1
+                reached(n_reached) = index2
+                if(.not.marked(index2))then
+                   marked(index2) = .true.
+                   n_members = n_members + 1
+                   members(n_members) = index2
+                end if
+             end if
+          end do
+       end do
+       hop_first = hop_last + 1
+    end do
+
+  end subroutine core_expand_atom_set
+
+
+! !!!: core_evaluate_energy_of_region
+
+  ! Calculates the energy of the tuples of atoms containing at least
+  ! one atom in focus. The region must contain all the atoms from which
+  ! these tuples are found in :func:`core_evaluate_local_interactions_of_atom`.
+  ! Only the local interactions and the real space part of Ewald summation
+  ! are included. The bond order factors must have been stored.
   !
-  ! *total_energy calculated total potential energy
-  subroutine core_calculate_energy(total_energy)
+  ! *n_members number of atoms in the region
+  ! *members the atoms in the region
+  ! *focus logical array marking the atoms in focus
+  ! *energy the calculated energy
+  subroutine core_evaluate_energy_of_region(n_members,members,focus,energy)
     implicit none
-    double precision, intent(out) :: total_energy
-    double precision :: dummy_stress(6)
+    integer, intent(in) :: n_members, members(:)
+    logical, intent(in) :: focus(:)
+    double precision, intent(out) :: energy
+    double precision :: stress(6)
+    double precision, allocatable :: atom_sums(:,:)
+    integer, pointer :: manybody_indices(:)
+    integer :: i
 
-    call core_loop_over_local_interactions(energy_evaluation_index,&
-         total_energy,temp_forces,temp_enegs,dummy_stress)
-    return
+    energy = 0.d0
+    stress = 0.d0
+    allocate(atom_sums(7,0))
+    nullify(manybody_indices)
+    allocate(manybody_indices(max(n_interactions,1)))
 
-  end subroutine core_calculate_energy
+    do i = 1, n_members
+       call core_evaluate_local_interactions_of_atom(members(i),energy_evaluation_index,&
+            energy,temp_forces,temp_enegs,stress,atom_sums,manybody_indices,focus)
+    end do
 
+    deallocate(manybody_indices)
+    deallocate(atom_sums)
 
-  ! !!!: list_atoms
+  end subroutine core_evaluate_energy_of_region
 
-  ! Prints some information on the atoms stored in the core in stdout.
-  subroutine list_atoms()
+
+! !!!: core_refresh_monte_carlo_data
+
+  ! Rebuilds the neighbor lists and recalculates the stored bond order
+  ! factors and the Ewald structure factors during a Monte Carlo simulation
+  ! (see :func:`core_monte_carlo`).
+  ! All the atoms get the same neighbor list cutoff, since swapping 
+  ! atoms may change the cutoffs of individual atoms.
+  ! The subcells are made larger than the list cutoff by twice the skin
+  ! so that the lists of single atoms can be updated with
+  ! :func:`core_update_neighbor_list_of_atom` as long as no atom
+  ! is listed at a position farther than the skin from its position at the time of
+  ! partitioning.
+  ! The simulation is run on all cpus, so in MPI the lists 
+  ! of all atoms are built.
+  !
+  ! *cutoff the largest cutoff of the interactions
+  ! *skin the skin width of the lists
+  ! *total_charge the sum of the charges (scaled for Ewald summation)
+  ! *partition_positions the positions of the atoms at the time of partitioning
+  subroutine core_refresh_monte_carlo_data(cutoff,skin,total_charge,partition_positions)
     implicit none
+    double precision, intent(in) :: cutoff, skin
+    double precision, intent(out) :: total_charge, partition_positions(:,:)
+    double precision, allocatable :: cutoffs(:)
+    double precision :: energy
     integer :: i
 
-    if(associated(atoms))then
-       write(*,*) "element, position, charge"    
+    allocate(cutoffs(size(atoms)))
+    cutoffs = cutoff + skin
+    call core_create_space_partitioning(cutoff + 3.d0*skin)
+    is_halo_atom = .not.is_my_atom
+    call core_build_neighbor_lists(cutoffs,skin)
+    deallocate(cutoffs)
+    do i = 1, size(atoms)
+       partition_positions(1:3,i) = atoms(i)%position
+    end do
+
+    use_saved_bond_order_factors = .true.
+    call core_empty_bond_order_storage()
+    call core_fill_bond_order_storage()
+
+    total_charge = 0.d0
+    if(evaluate_ewald)then
+       call calculate_ewald_energy(atoms,cell,ewald_cutoff,ewald_k_radius,ewald_k_cutoffs,ewald_sigma,&
+            ewald_epsilon,ewald_scaler,.false.,energy,.false.) ! in Potentials.f90
        do i = 1, size(atoms)
-          write(*,'(I7,I7,A,A,F10.4,F10.4,F10.4,F10.4)') i, atoms(i)%index," ", atoms(i)%element, &
-               atoms(i)%position(1), atoms(i)%position(2), atoms(i)%position(3), atoms(i)%charge
+          total_charge = total_charge + atoms(i)%charge*ewald_scaler(i)
        end do
-    else
-       write(*,*) "no atoms defined"
     end if
 
-  end subroutine list_atoms
+  end subroutine core_refresh_monte_carlo_data
+
+
+! !!!: core_monte_carlo
+
+  ! Runs a Metropolis Monte Carlo simulation in the canonical ensemble.
+  !
+  ! Each trial is one of three kinds of moves, chosen randomly according
+  ! to the given probabilities: displacing a single atom, swapping the 
+  ! elements of two atoms of different elements, or transferring charge
+  ! between two atoms. The move is accepted with the probability 
+  ! :math:`\min(1,e^{-\Delta E / k_B T})`.
+  !
+  ! The energy change of a trial is calculated locally, without evaluating
+  ! the energy of the whole system. Only the tuples of atoms containing
+  ! an atom whose position, element or charge changes, or whose bond order
+  ! factors may change, contribute to :math:`\Delta E`. These are found 
+  ! by searching the chains of neighbors leading to the changed atoms (see :func:`core_expand_atom_set`)
+  ! and their energies are calculated before and after the move with
+  ! :func:`core_evaluate_energy_of_region`. The stored bond order sums are
+  ! updated by the terms involving the changed atoms only, and the change in the
+  ! reciprocal part of Ewald summation is obtained from the change in the structure
+  ! factors (see :func:`calculate_ewald_energy_change`).
+  ! So, the cost of a trial does not depend on the size of the system.
+  !
+  ! The neighbor lists are built with a skin. Before an atom would move farther 
+  ! than half the skin from the position it had when its list was last updated, 
+  ! the lists of the atom and its neighbors are updated (see :func:`core_update_neighbor_list_of_atom`).
+  ! Only if the atom has drifted farther than the skin from where it was when the space 
+  ! was partitioned, the lists are rebuilt and all stored data is calculated again
+  ! (see :func:`core_refresh_monte_carlo_data`), 
+  ! which also removes any accumulated rounding errors. Particle mesh Ewald 
+  ! summation is not supported. In MPI, all cpus run the same simulation.
+  !
+  ! The random numbers are drawn from the Mersenne Twister generator, which
+  ! must have been initialized.
+  !
+  ! called from PyInterface: :func:`run_monte_carlo`
+  !
+  ! *n_trials number of trial moves
+  ! *temperature the temperature in units of energy, :math:`k_B T`
+  ! *probabilities the relative probabilities of displacement, swap and charge transfer moves
+  ! *max_displacement the maximum displacement of an atom along each coordinate axis
+  ! *max_charge_transfer the maximum amount of charge transferred between two atoms
+  ! *cutoff the largest cutoff of the interactions
+  ! *skin the skin width of the neighbor lists, must be larger than :math:`2 \sqrt{3}` times the maximum displacement
+  ! *positions the positions of the atoms at the end, in the order of atom indices
+  ! *charges the charges of the atoms at the end, in the order of atom indices
+  ! *species the index of the atom whose element, mass and charge each atom has at the end, in the order of atom indices
+  ! *attempts the numbers of attempted displacement, swap and charge transfer moves
+  ! *accepted the numbers of accepted displacement, swap and charge transfer moves
+  ! *energy_change the total change in energy
+  subroutine core_monte_carlo(n_trials,temperature,probabilities,max_displacement,max_charge_transfer,&
+       cutoff,skin,positions,charges,species,attempts,accepted,energy_change)
+    implicit none
+    integer, intent(in) :: n_trials
+    double precision, intent(in) :: temperature, probabilities(3), max_displacement, &
+         max_charge_transfer, cutoff, skin
+    double precision, intent(out) :: positions(:,:), charges(:), energy_change
+    integer, intent(out) :: species(:), attempts(3), accepted(3)
+    integer, parameter :: displacement_move = 1, swap_move = 2, charge_move = 3
+    integer :: n_atoms, trial, move, i, j, k, index1, index2, n_moved, moved(2), &
+         n_moved_focus, n_focus, n_reach, n_region, n_slots, n_targets, tmp_index
+    integer, allocatable :: focus_atoms(:), reach_atoms(:), region_atoms(:), slot_groups(:)
+    logical, allocatable :: focus(:), in_reach(:), in_region(:)
+    double precision, allocatable :: partition_positions(:,:)
+    double precision, allocatable :: sums_before(:,:), sums_after(:,:), backup_sums(:,:), &
+         backup_factors(:,:), factor_change(:,:)
+    double precision :: rand, cumulative(3), step(3), shift(3), old_positions(3,2), &
+         new_positions(3,2), old_charges(2), new_charges(2), delta, &
+         energy_before, energy_after, ewald_change, trial_change, total_charge, &
+         bo_radii(4), pot_radii(4), hop_tolerance
+    logical :: accept
 
+    n_atoms = size(atoms)
+    attempts = 0
+    accepted = 0
+    energy_change = 0.d0
+
+    cumulative(1) = probabilities(1)
+    cumulative(2) = cumulative(1) + probabilities(2)
+    cumulative(3) = cumulative(2) + probabilities(3)
+    cumulative = cumulative / cumulative(3)
+
+    ! The number of neighbor hops and the hop lengths needed for finding
+    ! the atoms whose bond order factors may change and the atoms whose
+    ! interactions may include the changed atoms.
+    ! A tuple of n atoms is a chain of n-1 bonds shorter than the cutoff,
+    ! so the longest cutoffs are recorded for each number of targets.
+    pot_radii = 0.d0
+    do i = 1, n_interactions
+       call get_number_of_targets_of_potential_index(interactions(i)%type_index,&
+            n_targets) ! in Potentials.f90
+       pot_radii(n_targets) = max(pot_radii(n_targets), interactions(i)%cutoff)
+    end do
+    bo_radii = 0.d0
+    do i = 1, n_bond_factors
+       call get_number_of_targets_of_bond_order_factor_index(bond_factors(i)%type_index,&
+            n_targets) ! in Potentials.f90
+       bo_radii(n_targets) = max(bo_radii(n_targets), bond_factors(i)%cutoff)
+    end do
 
-! !!!: list_cell
+    allocate(focus_atoms(n_atoms))
+    allocate(reach_atoms(n_atoms))
+    allocate(region_atoms(n_atoms))
+    allocate(focus(n_atoms))
+    allocate(in_reach(n_atoms))
+    allocate(in_region(n_atoms))
+    focus = .false.
+    in_reach = .false.
+    in_region = .false.
+    allocate(partition_positions(3,n_atoms))
+    do i = 1, n_atoms
+       species(i) = i
+    end do
 
-  ! Prints some information on the supercell stored in the core in stdout.
-  subroutine list_cell()
-    implicit none
-    integer :: i
+    call core_refresh_monte_carlo_data(cutoff,skin,total_charge,partition_positions)
 
-    write(*,*) "cell"
-    do i = 1, 3
-        write(*,'(F10.4,F10.4,F10.4)') cell%vectors(1:3,i)
+    ! the bond order factor groups of the storage slots
+    n_slots = n_saved_bond_order_factors
+    allocate(slot_groups(n_slots))
+    do i = lbound(group_index_save_slot,1), ubound(group_index_save_slot,1)
+       if(group_index_save_slot(i) > 0)then
+          slot_groups(group_index_save_slot(i)) = i
+       end if
     end do
-    write(*,*) "pbc: ", cell%periodic(1:3)
+    if(n_slots == 0)then
+       bo_radii = 0.d0
+    end if
+    allocate(sums_before(n_atoms,n_slots))
+    allocate(sums_after(n_atoms,n_slots))
+    allocate(backup_sums(n_atoms,n_slots))
+    allocate(backup_factors(n_atoms,n_slots))
+    sums_before = 0.d0
+    sums_after = 0.d0
+    if(evaluate_ewald)then
+       allocate(factor_change(2,n_ewald_k_vectors))
+    end if
 
-  end subroutine list_cell
+    do trial = 1, n_trials
 
+       ! choose the move
+       call genrand_real2(rand) ! in Mersenne.f90
+       move = displacement_move
+       do while(rand >= cumulative(move) .and. move < 3)
+          move = move + 1
+       end do
+       attempts(move) = attempts(move) + 1
 
-! !!!: list_interactions
+       select case(move)
+       case(displacement_move)
 
-  ! Prints some information on the potentials stored in the core in stdout.
-  subroutine list_interactions()
-    implicit none
-    integer :: i, j
-    
-    write(*,*) "interactions"
-    do i = 1, n_interactions
-       write(*,'(A,I5,F10.4)') "type, cutoff ", interactions(i)%type_index, interactions(i)%cutoff
-       write(*,*) "params ", interactions(i)%parameters
-       if(interactions(i)%filter_elements)then
-          write(*,*) "         symbols ", interactions(i)%apply_elements
-          write(*,*) "original symbols ", interactions(i)%original_elements
+          call genrand_real2(rand)
+          tmp_index = min(int(rand*n_atoms)+1, n_atoms)
+          do k = 1, 3
+             call genrand_real2(rand)
+             step(k) = (2.d0*rand - 1.d0)*max_displacement
+          end do
+          ! If the atom would move too far for the neighbor lists to
+          ! be valid, the lists around the atom are updated first. 
+          ! If the atom has drifted too far from the position it had when 
+          ! the space was partitioned, all the lists are rebuilt instead.
+          ! The atoms may then be reordered, so the atom is picked by its index.
+          index1 = atom_storage_index(tmp_index)
+          shift = atoms(index1)%position + step - neighbor_reference_positions(1:3,index1)
+          if(.norm.shift > 0.5d0*skin)then
+             shift = atoms(index1)%position - partition_positions(1:3,index1)
+             if(.norm.shift > skin)then
+                call core_refresh_monte_carlo_data(cutoff,skin,total_charge,partition_positions)
+                index1 = atom_storage_index(tmp_index)
+             else
+                call core_update_neighbor_list_of_atom(index1,cutoff+skin,partition_positions)
+             end if
+          end if
+          n_moved = 1
+          moved(1) = index1
+          hop_tolerance = .norm.step
+          old_positions(1:3,1) = atoms(index1)%position
+          new_positions(1:3,1) = atoms(index1)%position + step
+          if(evaluate_ewald)then
+             old_charges(1) = atoms(index1)%charge*ewald_scaler(index1)
+             new_charges(1) = old_charges(1)
+          end if
+
+       case(swap_move)
+
+          call genrand_real2(rand)
+          index1 = min(int(rand*n_atoms)+1, n_atoms)
+          index2 = index1
+          do i = 1, 1000
+             call genrand_real2(rand)
+             j = min(int(rand*n_atoms)+1, n_atoms)
+             if(atoms(j)%element /= atoms(index1)%element)then
+                index2 = j
+                exit
+             end if
+          end do
+          if(index2 == index1)then
+             ! no atom of a different element was found
+             cycle
+          end if
+          n_moved = 2
+          moved(1:2) = (/ index1, index2 /)
+          hop_tolerance = 0.d0
+          if(evaluate_ewald)then
+             old_positions(1:3,1) = atoms(index1)%position
+             old_positions(1:3,2) = atoms(index2)%position
+             new_positions = old_positions
+             old_charges(1) = atoms(index1)%charge*ewald_scaler(index1)
+             old_charges(2) = atoms(index2)%charge*ewald_scaler(index2)
+             new_charges(1) = atoms(index2)%charge*ewald_scaler(index1)
+             new_charges(2) = atoms(index1)%charge*ewald_scaler(index2)
+          end if
+
+       case(charge_move)
+
+          if(n_atoms < 2)then
+             cycle
+          end if
+          call genrand_real2(rand)
+          index1 = min(int(rand*n_atoms)+1, n_atoms)
+          index2 = index1
+          do while(index2 == index1)
+             call genrand_real2(rand)
+             index2 = min(int(rand*n_atoms)+1, n_atoms)
+          end do
+          call genrand_real2(rand)
+          delta = (2.d0*rand - 1.d0)*max_charge_transfer
+          n_moved = 2
+          moved(1:2) = (/ index1, index2 /)
+          hop_tolerance = 0.d0
+          if(evaluate_ewald)then
+             old_positions(1:3,1) = atoms(index1)%position
+             old_positions(1:3,2) = atoms(index2)%position
+             new_positions = old_positions
+             old_charges(1) = atoms(index1)%charge*ewald_scaler(index1)
+             old_charges(2) = atoms(index2)%charge*ewald_scaler(index2)
+             new_charges(1) = (atoms(index1)%charge + delta)*ewald_scaler(index1)
+             new_charges(2) = (atoms(index2)%charge - delta)*ewald_scaler(index2)
+          end if
+
+       end select
+
+       ! The atoms whose bond order factors may change are in focus:
+       ! all the interactions involving them are recalculated.
+       ! The terms of their bond order sums are found starting from these
+       ! atoms and they contribute to the sums of the atoms in reach.
+       n_focus = 0
+       do i = 1, n_moved
+          if(.not.focus(moved(i)))then
+             focus(moved(i)) = .true.
+             n_focus = n_focus + 1
+             focus_atoms(n_focus) = moved(i)
+          end if
+       end do
+       n_moved_focus = n_focus
+       do k = 2, 4
+          if(bo_radii(k) > 0.d0)then
+             call core_expand_atom_set(1,n_moved_focus,k-1,bo_radii(k),hop_tolerance,n_focus,focus_atoms,focus)
+          end if
+       end do
+       n_reach = 0
+       if(n_slots > 0)then
+          n_reach = n_focus
+          reach_atoms(1:n_reach) = focus_atoms(1:n_focus)
+          in_reach(reach_atoms(1:n_reach)) = .true.
+          do k = 2, 4
+             if(bo_radii(k) > 0.d0)then
+                call core_expand_atom_set(1,n_focus,k-1,bo_radii(k),hop_tolerance,n_reach,reach_atoms,in_reach)
+             end if
+          end do
        end if
-       if(interactions(i)%filter_tags)then
-          write(*,*) "         tags ", interactions(i)%apply_tags
-          write(*,*) "original tags ", interactions(i)%original_tags
+
+       ! The tuples containing atoms in focus are found starting from the atoms in the region,
+       ! i.e., the atoms from which a chain of bonds shorter than the cutoffs leads to
+       ! an atom in focus. The lengths of the bonds are measured before the move, and
+       ! the bonds of a displaced atom may shorten by up to the length of the step.
+       n_region = n_focus
+       region_atoms(1:n_focus) = focus_atoms(1:n_focus)
+       in_region(region_atoms(1:n_region)) = .true.
+       do k = 2, 4
+          if(pot_radii(k) > 0.d0)then
+             call core_expand_atom_set(1,n_focus,k-1,pot_radii(k),hop_tolerance,n_region,region_atoms,in_region)
+          end if
+       end do
+       if(evaluate_ewald)then
+          call core_expand_atom_set(1,n_focus,1,ewald_cutoff,hop_tolerance,n_region,region_atoms,in_region)
        end if
-       if(interactions(i)%filter_indices)then
-          write(*,*) "         indices ", interactions(i)%apply_indices
-          write(*,*) "original indices ", interactions(i)%original_indices
+
+       ! energy before the move
+       do j = 1, n_slots
+          do i = 1, n_focus
+             call core_add_bond_order_sums_of_atom(slot_groups(j),focus_atoms(i),sums_before(:,j))
+          end do
+       end do
+       call core_evaluate_energy_of_region(n_region,region_atoms,focus,energy_before)
+
+       ! make the move
+       select case(move)
+       case(displacement_move)
+          atoms(index1)%position = new_positions(1:3,1)
+       case(swap_move)
+          call core_swap_atom_species(index1,index2)
+       case(charge_move)
+          atoms(index1)%charge = atoms(index1)%charge + delta
+          atoms(index2)%charge = atoms(index2)%charge - delta
+       end select
+
+       ! update the bond order factors
+       do j = 1, n_slots
+          do i = 1, n_focus
+             call core_add_bond_order_sums_of_atom(slot_groups(j),focus_atoms(i),sums_after(:,j))
+          end do
+          do i = 1, n_focus
+             k = focus_atoms(i)
+             backup_sums(i,j) = saved_bond_order_sums(k,j)
+             backup_factors(i,j) = saved_bond_order_factors(k,j)
+             saved_bond_order_sums(k,j) = saved_bond_order_sums(k,j) + sums_after(k,j) - sums_before(k,j)
+             call core_post_process_bond_order_factor_of_atom(slot_groups(j),k,&
+                  saved_bond_order_sums(k,j),saved_bond_order_factors(k,j))
+          end do
+          sums_before(reach_atoms(1:n_reach),j) = 0.d0
+          sums_after(reach_atoms(1:n_reach),j) = 0.d0
+       end do
+
+       ! energy after the move
+       call core_evaluate_energy_of_region(n_region,region_atoms,focus,energy_after)
+       trial_change = energy_after - energy_before
+       if(evaluate_ewald)then
+          call calculate_ewald_energy_change(old_positions(1:3,1:n_moved),new_positions(1:3,1:n_moved),&
+               old_charges(1:n_moved),new_charges(1:n_moved),cell,ewald_k_cutoffs,ewald_sigma,&
+               ewald_epsilon,total_charge,ewald_change,factor_change) ! in Potentials.f90
+          trial_change = trial_change + ewald_change
        end if
-       if(interactions(i)%pot_index >= 0)then
-          write(*,*) "bond order index ", interactions(i)%pot_index
+
+       ! Metropolis criterion
+       accept = (trial_change <= 0.d0)
+       if(.not.accept .and. temperature > 0.d0)then
+          call genrand_real2(rand)
+          accept = (rand < exp(-trial_change/temperature))
        end if
-       if(size(interactions(i)%multipliers) > 0)then
-          do j = 1, size(interactions(i)%multipliers)
-             write(*,*) "      multiplier ", interactions(i)%multipliers(j)%type_index, &
-                  interactions(i)%multipliers(j)%parameters
+
+       if(accept)then
+          accepted(move) = accepted(move) + 1
+          energy_change = energy_change + trial_change
+          if(evaluate_ewald)then
+             s_factor(1:2,1:n_ewald_k_vectors) = s_factor(1:2,1:n_ewald_k_vectors) + factor_change
+             total_charge = total_charge + sum(new_charges(1:n_moved)) - sum(old_charges(1:n_moved))
+          end if
+          if(move == swap_move)then
+             tmp_index = species(atoms(index1)%index)
+             species(atoms(index1)%index) = species(atoms(index2)%index)
+             species(atoms(index2)%index) = tmp_index
+          end if
+       else
+          select case(move)
+          case(displacement_move)
+             atoms(index1)%position = old_positions(1:3,1)
+          case(swap_move)
+             call core_swap_atom_species(index1,index2)
+          case(charge_move)
+             atoms(index1)%charge = atoms(index1)%charge - delta
+             atoms(index2)%charge = atoms(index2)%charge + delta
+          end select
+          do j = 1, n_slots
+             do i = 1, n_focus
+                saved_bond_order_sums(focus_atoms(i),j) = backup_sums(i,j)
+                saved_bond_order_factors(focus_atoms(i),j) = backup_factors(i,j)
+             end do
           end do
        end if
-       write(*,*) ""
+
+       focus(focus_atoms(1:n_focus)) = .false.
+       in_reach(reach_atoms(1:n_reach)) = .false.
+       in_region(region_atoms(1:n_region)) = .false.
+
+    end do
+
+    ! Stop using the stored bond order factors so that they
+    ! are not used in error after the atoms have been moved.
+    use_saved_bond_order_factors = .false.
+    call core_empty_bond_order_storage()
+
+    do i = 1, n_atoms
+       positions(1:3,atoms(i)%index) = atoms(i)%position
+       charges(atoms(i)%index) = atoms(i)%charge
     end do
 
-  end subroutine list_interactions
+    deallocate(focus_atoms)
+    deallocate(reach_atoms)
+    deallocate(region_atoms)
+    deallocate(focus)
+    deallocate(in_reach)
+    deallocate(in_region)
+    deallocate(partition_positions)
+    deallocate(slot_groups)
+    deallocate(sums_before)
+    deallocate(sums_after)
+    deallocate(backup_sums)
+    deallocate(backup_factors)
+    if(evaluate_ewald)then
+       deallocate(factor_change)
+    end if
 
+  end subroutine core_monte_carlo
 
-! !!!: list_bonds
 
-  ! Prints some information on the bond order factors stored in the core in stdout.
-  subroutine list_bonds()
+! !!!: core_update_neighbor_list_of_atom
+
+  ! Updates the neighbor list of a single atom which has moved, 
+  ! as well as the lists of its old and new neighbors,
+  ! without rebuilding the other lists.
+  ! The reference position of the atom is set to its current position,
+  ! and the neighbors are the atoms whose reference positions are within
+  ! the given distance of it.
+  !
+  ! The neighbors are searched in the subcells adjacent to the subcell
+  ! the atom was assigned to when the space was partitioned. This finds
+  ! all the neighbors only if the subcells are larger than the list cutoff
+  ! plus twice the largest distance between the reference position of any
+  ! atom and its position at the time of partitioning.
+  ! The positions at the time of partitioning must be given, since
+  ! the periodic offsets of the subcells are calculated from them.
+  !
+  ! *index1 index of the atom
+  ! *list_cutoff the cutoff of the neighbor lists
+  ! *partition_positions the positions of the atoms when the space was partitioned
+  subroutine core_update_neighbor_list_of_atom(index1,list_cutoff,partition_positions)
     implicit none
-    integer :: i,j
+    integer, intent(in) :: index1
+    double precision, intent(in) :: list_cutoff, partition_positions(:,:)
+    integer, allocatable :: nbors(:), offsets(:,:), touched(:), other_nbors(:), other_offsets(:,:)
+    integer :: cell_indices(3), nbor_cell_indices(3), neighbor_offset(3), offset(3), &
+         atom1_wrap_offset(3), atom2_wrap_offset(3), i_n, j_n, k_n, j, k, n_nbs, &
+         n_candidates, n_touched, n_other, index2, neighbor_slot
+    logical :: neighbor_include
+    double precision :: separation(3), dummy1(3)
+
+    ! the old neighbors
+    allocate(touched(atoms(index1)%neighbor_list%n_neighbors))
+    n_touched = atoms(index1)%neighbor_list%n_neighbors
+    touched(1:n_touched) = atoms(index1)%neighbor_list%neighbors(1:n_touched)
+
+    ! the number of atoms in the adjacent subcells is the maximum number of neighbors
+    cell_indices = atoms(index1)%subcell_indices
+    n_candidates = 0
+    do k_n = -1,1
+       do j_n = -1,1
+          do i_n = -1,1
+             call get_neighbor_subcell(cell,cell_indices,(/ i_n, j_n, k_n /),&
+                  nbor_cell_indices,neighbor_offset,neighbor_include) ! in Geometry.f90
+             if(neighbor_include)then
+                neighbor_slot = subcell_slot(cell,nbor_cell_indices) ! in Geometry.f90
+                if(neighbor_slot > 0)then
+                   n_candidates = n_candidates + cell%subcell_first(neighbor_slot+1) - cell%subcell_first(neighbor_slot)
+                end if
+             end if
+          end do
+       end do
+    end do
 
-    write(*,*) "bond order factors"
-    do i = 1, n_bond_factors
-       write(*,'(A,I5,F10.4)') "type, cutoff ", bond_factors(i)%type_index, bond_factors(i)%cutoff
-       write(*,*) "params "
-       do j = 1, size(bond_factors(i)%n_params)
-          write(*,*) j, " : ", bond_factors(i)%parameters(:,j)
+    neighbor_reference_positions(1:3,index1) = atoms(index1)%position
+    allocate(nbors(n_candidates))
+    allocate(offsets(3,n_candidates))
+    n_nbs = 0
+
+    call wrapped_coordinates(partition_positions(1:3,index1),cell,dummy1,atom1_wrap_offset) ! in Geometry.f90
+    do k_n = -1,1
+       do j_n = -1,1
+          do i_n = -1,1
+
+             call get_neighbor_subcell(cell,cell_indices,(/ i_n, j_n, k_n /),&
+                  nbor_cell_indices,neighbor_offset,neighbor_include) ! in Geometry.f90
+             if(.not.neighbor_include)then
+                cycle
+             end if
+             neighbor_slot = subcell_slot(cell,nbor_cell_indices) ! in Geometry.f90
+             if(neighbor_slot == 0)then
+                cycle
+             end if
+
+             do j = cell%subcell_first(neighbor_slot), cell%subcell_first(neighbor_slot+1)-1
+                index2 = cell%subcell_atoms(j)
+                call wrapped_coordinates(partition_positions(1:3,index2),cell,dummy1,atom2_wrap_offset) ! in Geometry.f90
+                offset = neighbor_offset - atom1_wrap_offset + atom2_wrap_offset
+                if(index2 == index1 .and. all(offset == 0))then
+                   cycle
+                end if
+                call separation_vector(neighbor_reference_positions(1:3,index1), &
+                     neighbor_reference_positions(1:3,index2), &
+                     offset, cell, separation) ! in Geometry.f90
+                if((separation.o.separation) < list_cutoff*list_cutoff)then
+                   n_nbs = n_nbs + 1
+                   nbors(n_nbs) = index2
+                   offsets(1:3,n_nbs) = offset
+                end if
+             end do
+
+          end do
        end do
-       write(*,*) "symbols ",bond_factors(i)%apply_elements
-       write(*,*) "bond order index ", bond_factors(i)%group_index
     end do
 
-  end subroutine list_bonds
+    call assign_neighbor_list(n_nbs,atoms(index1)%neighbor_list,nbors(1:n_nbs),offsets(1:3,1:n_nbs)) ! in Geometry.f90
+    call core_divide_neighbor_list_of_atom_in_tiers(index1)
 
-  ! Debug routine for Ewald
-  subroutine core_get_ewald_energy(real_cut, k_cut, reciprocal_cut, sigma, epsilon, energy)
-    implicit none
-    double precision, intent(in) :: real_cut, k_cut, sigma, epsilon
-    integer, intent(in) :: reciprocal_cut(3)
-    double precision, intent(out) :: energy
-    double precision :: scaler(size(atoms))
+    ! Replace the atom in the lists of its old and new neighbors.
+    ! The old neighbors are handled first, then the new neighbors which were not old ones.
+    do k = 1, n_touched + n_nbs
+       if(k <= n_touched)then
+          index2 = touched(k)
+          if(any(touched(1:k-1) == index2))then
+             cycle
+          end if
+       else
+          index2 = nbors(k-n_touched)
+          if(any(touched(1:n_touched) == index2) .or. any(nbors(1:k-n_touched-1) == index2))then
+             cycle
+          end if
+       end if
+       if(index2 == index1)then
+          cycle
+       end if
 
-    scaler = 1.d0
+       allocate(other_nbors(atoms(index2)%neighbor_list%n_neighbors+n_nbs))
+       allocate(other_offsets(3,atoms(index2)%neighbor_list%n_neighbors+n_nbs))
+       n_other = 0
+       do j = 1, atoms(index2)%neighbor_list%n_neighbors
+          if(atoms(index2)%neighbor_list%neighbors(j) /= index1)then
+             n_other = n_other + 1
+             other_nbors(n_other) = atoms(index2)%neighbor_list%neighbors(j)
+             other_offsets(1:3,n_other) = atoms(index2)%neighbor_list%pbc_offsets(1:3,j)
+          end if
+       end do
+       do j = 1, n_nbs
+          if(nbors(j) == index2)then
+             n_other = n_other + 1
+             other_nbors(n_other) = index1
+             other_offsets(1:3,n_other) = -offsets(1:3,j)
+          end if
+       end do
+       call assign_neighbor_list(n_other,atoms(index2)%neighbor_list,&
+            other_nbors(1:n_other),other_offsets(1:3,1:n_other)) ! in Geometry.f90
+       call core_divide_neighbor_list_of_atom_in_tiers(index2)
+       deallocate(other_nbors)
+       deallocate(other_offsets)
+    end do
 
-    call calculate_ewald_energy(atoms,cell,real_cut,k_cut,reciprocal_cut,sigma,&
-         epsilon,scaler,.true.,energy)
+    deallocate(nbors)
+    deallocate(offsets)
+    deallocate(touched)
 
-  end subroutine core_get_ewald_energy
+  end subroutine core_update_neighbor_list_of_atom
 
 
+! !!!: core_molecular_dynamics
 
-  ! Sets the parameters for Ewald summation in the core. 
+  ! Integrates the equations of motion of the atoms with the velocity Verlet algorithm.
   !
-  ! *real_cut the real-space cutoff
-  ! *k_radius the k-space cutoff (in inverse length)
-  ! *reciprocal_cut the k-space cutoffs (in numbers of k-space cells)
-  ! *sigma the split parameter
-  ! *epsilon electric constant
-  ! *scaler scaling factors for the individual charges
-  subroutine core_set_ewald_parameters(real_cut, k_radius, reciprocal_cut, sigma, epsilon, scaler)
+  ! The positions and momenta of the atoms in the core are propagated for
+  ! the given number of steps without returning to Python. The neighbor lists are
+  ! rebuilt only when some atom has moved farther than half the skin since the
+  ! previous build (see :func:`core_get_max_displacement`).
+  !
+  ! The temperature may be controlled with a thermostat. The Langevin
+  ! thermostat adds friction and random forces to the momenta after each step,
+  !
+  ! .. math::
+  !
+  !    \mathbf{p} \leftarrow e^{-\gamma \Delta t} \mathbf{p} + \sqrt{(1 - e^{-2 \gamma \Delta t}) m k_B T} \boldsymbol{\xi},
+  !
+  ! where :math:`\boldsymbol{\xi}` are independent normally distributed random numbers drawn
+  ! from the Mersenne Twister generator, which must have been initialized. 
+  ! The Berendsen thermostat scales the momenta by
+  !
+  ! .. math::
+  !
+  !    \lambda = \sqrt{1 + \frac{\Delta t}{\tau}\left(\frac{T}{T_\mathrm{inst}} - 1\right)},
+  !
+  ! limited between 0.9 and 1.1, where :math:`T_\mathrm{inst}` is the instantaneous temperature.
+  ! Fixed atoms do not move and their momenta are set to zero.
+  !
+  ! The forces must be given in the order of atom indices. If they
+  ! are not known, they are calculated first. At the end, the forces
+  ! at the final positions are returned, so they can be given to the next call.
+  !
+  ! called from PyInterface: :func:`run_molecular_dynamics`
+  !
+  ! *n_steps number of time steps
+  ! *timestep the length of the time step
+  ! *thermostat 0 for no thermostat, 1 for Langevin, 2 for Berendsen
+  ! *temperature the temperature of the thermostat in units of energy, :math:`k_B T`
+  ! *coupling the friction coefficient :math:`\gamma` for Langevin or the time constant :math:`\tau` for Berendsen
+  ! *cutoffs the cutoffs of the neighbor lists of the atoms, including the skin, in the order of atom indices
+  ! *skin the skin width of the neighbor lists
+  ! *fixed true for the atoms which do not move, in the order of atom indices
+  ! *forces the forces acting on the atoms, in the order of atom indices
+  ! *forces_ready true if the forces are given, false if they should be calculated first
+  ! *positions the positions of the atoms at the end, in the order of atom indices
+  ! *momenta the momenta of the atoms at the end, in the order of atom indices
+  ! *potential_energy the potential energy at the end
+  ! *kinetic_energy the kinetic energy at the end
+  ! *n_rebuilds the number of times the neighbor lists were rebuilt
+  subroutine core_molecular_dynamics(n_steps,timestep,thermostat,temperature,coupling,&
+       cutoffs,skin,fixed,forces,forces_ready,positions,momenta,potential_energy,&
+       kinetic_energy,n_rebuilds)
     implicit none
-    double precision, intent(in) :: real_cut, k_radius, sigma, epsilon, scaler(:)
-    integer, intent(in) :: reciprocal_cut(3)
+    integer, intent(in) :: n_steps, thermostat
+    double precision, intent(in) :: timestep, temperature, coupling, cutoffs(:), skin
+    logical, intent(in) :: fixed(:), forces_ready
+    double precision, intent(inout) :: forces(:,:)
+    double precision, intent(out) :: positions(:,:), momenta(:,:), potential_energy, &
+         kinetic_energy
+    integer, intent(out) :: n_rebuilds
+    integer, parameter :: no_thermostat = 0, langevin_thermostat = 1, berendsen_thermostat = 2
+    integer :: step, i, k, n_free
+    double precision :: stress(6), max_displacement, damping, noise, scaling, &
+         rand1, rand2, gaussian
+
+    n_rebuilds = 0
+    n_free = 0
+    do i = 1, size(atoms)
+       if(fixed(atoms(i)%index))then
+          atoms(i)%momentum = 0.d0
+       else
+          n_free = n_free + 1
+       end if
+    end do
+    damping = 1.d0
+    if(thermostat == langevin_thermostat)then
+       damping = exp(-coupling*timestep)
+    end if
 
-    evaluate_ewald = .true.
-    ewald_k_cutoffs = reciprocal_cut
-    ewald_k_radius = k_radius
-    ewald_cutoff = real_cut
-    ewald_sigma = sigma
-    ewald_epsilon = epsilon
-    if(ewald_allocated)then
-       deallocate(ewald_scaler)
-    else
-       nullify(ewald_scaler)
+    if(.not.forces_ready)then
+       call core_calculate_forces(forces,stress)
+       call core_restore_atom_order_of_vectors(forces)
     end if
-    allocate(ewald_scaler(size(atoms)))
-    ewald_scaler = scaler
-    ewald_allocated = .true.
-    
-    call deallocate_ewald_arrays()
-    call allocate_ewald_arrays(size(atoms))
 
-  end subroutine core_set_ewald_parameters
+    do step = 1, n_steps
+
+       ! half a kick and a drift
+       do i = 1, size(atoms)
+          if(fixed(atoms(i)%index))then
+             cycle
+          end if
+          atoms(i)%momentum = atoms(i)%momentum + 0.5d0*timestep*forces(1:3,atoms(i)%index)
+          atoms(i)%position = atoms(i)%position + timestep*atoms(i)%momentum/atoms(i)%mass
+       end do
 
+       ! The atoms may be reordered when the lists are rebuilt, 
+       ! but the forces are stored in the order of atom indices.
+       call core_get_max_displacement(max_displacement)
+       if(max_displacement > 0.5d0*skin)then
+          call core_create_space_partitioning(maxval(cutoffs))
+          call core_build_neighbor_lists(cutoffs,skin)
+          n_rebuilds = n_rebuilds + 1
+       end if
 
-  ! Partitions the simulation volume in subvolumes for fast neighbor searching
-  !
-  ! *max_cutoff the maximum cutoff radius for neighbor search
-  subroutine core_create_space_partitioning(max_cutoff)
-    implicit none
-    double precision, intent(in) :: max_cutoff
-    integer :: splits(3), i,j,k,in,jn,kn
+       ! the other half of the kick
+       call core_calculate_forces(forces,stress)
+       call core_restore_atom_order_of_vectors(forces)
+       do i = 1, size(atoms)
+          if(fixed(atoms(i)%index))then
+             cycle
+          end if
+          atoms(i)%momentum = atoms(i)%momentum + 0.5d0*timestep*forces(1:3,atoms(i)%index)
+       end do
 
-    call get_optimal_splitting(cell,max_cutoff,splits)
-    call divide_cell(cell,splits)
+       select case(thermostat)
+       case(langevin_thermostat)
+          do i = 1, size(atoms)
+             if(fixed(atoms(i)%index))then
+                cycle
+             end if
+             noise = sqrt((1.d0 - damping*damping)*atoms(i)%mass*temperature)
+             do k = 1, 3
+                ! Box-Muller transformation
+                call genrand_real2(rand1) ! in Mersenne.f90
+                call genrand_real2(rand2) ! in Mersenne.f90
+                gaussian = sqrt(-2.d0*log(1.d0-rand1))*cos(2.d0*pi*rand2)
+                atoms(i)%momentum(k) = damping*atoms(i)%momentum(k) + noise*gaussian
+             end do
+          end do
+       case(berendsen_thermostat)
+          call core_get_kinetic_energy(kinetic_energy)
+          if(kinetic_energy > 0.d0 .and. n_free > 0)then
+             scaling = sqrt(1.d0 + timestep/coupling*(1.5d0*n_free*temperature/kinetic_energy - 1.d0))
+             scaling = min(max(scaling,0.9d0),1.1d0)
+             do i = 1, size(atoms)
+                if(.not.fixed(atoms(i)%index))then
+                   atoms(i)%momentum = scaling*atoms(i)%momentum
+                end if
+             end do
+          end if
+       end select
+
+    end do
+
+    call core_calculate_energy(potential_energy)
+    call core_get_kinetic_energy(kinetic_energy)
     do i = 1, size(atoms)
-       call find_subcell_for_atom(cell,atoms(i))
+       positions(1:3,atoms(i)%index) = atoms(i)%position
+       momenta(1:3,atoms(i)%index) = atoms(i)%momentum
     end do
 
-  end subroutine core_create_space_partitioning
+  end subroutine core_molecular_dynamics
 
-  ! Builds the neighbor lists in the core.
-  ! The simulation cell must be partitioned with :func:`core_create_space_partitioning` 
-  ! before this routine can be called.
-  !
-  ! *cutoffs list of cutoffs, atom by atom
-  subroutine core_build_neighbor_lists(cutoffs)
-    implicit none
-    double precision, intent(in) :: cutoffs(:)
-    integer :: cell_indices(3), i,j, i_n, j_n, k_n, neighbor_offset(3), atom1_index, atom2_index, &
-         max_n_nbors=100, global_max, tmp_max, &
-         atom1_wrap_offset(3), atom2_wrap_offset(3), n_atoms
-    integer, pointer, save ::  nbors_and_offsets(:,:,:), n_nbs(:), &
-        total_n_nbs(:)
-    type(subcell) :: atom_cell, neighbor_cell
-    logical :: neighbor_include, first_run = .true.
-    double precision :: separation(3), distance, dummy1(3)
-    
-    n_atoms = size(atoms) 
-    if(first_run)then
-       nullify(nbors_and_offsets)
-       allocate(nbors_and_offsets(4,max_n_nbors,n_atoms))
-       nullify(n_nbs)
-       allocate(n_nbs(n_atoms))
-       nullify(total_n_nbs)
-       allocate(total_n_nbs(n_atoms))
-       first_run = .false.
-    else if(size(nbors_and_offsets(1,1,:)) /= n_atoms)then
-       deallocate(nbors_and_offsets)
-       allocate(nbors_and_offsets(4,max_n_nbors,n_atoms))
-       deallocate(n_nbs)
-       allocate(n_nbs(n_atoms))
-       deallocate(total_n_nbs)
-       allocate(total_n_nbs(n_atoms))
-    end if
 
-    n_nbs = 0
+! !!!: core_get_kinetic_energy
 
-    nbors_and_offsets = 0
+  ! Returns the kinetic energy of the atoms, :math:`\sum_\alpha p_\alpha^2/(2 m_\alpha)`.
+  !
+  ! *kinetic_energy the kinetic energy
+  subroutine core_get_kinetic_energy(kinetic_energy)
+    implicit none
+    double precision, intent(out) :: kinetic_energy
+    integer :: i
 
-    do atom1_index = 1, size(atoms)
+    kinetic_energy = 0.d0
+    do i = 1, size(atoms)
+       kinetic_energy = kinetic_energy + 0.5d0*(atoms(i)%momentum.o.atoms(i)%momentum)/atoms(i)%mass
+    end do
 
-       if(is_my_atom(atom1_index))then
-          
-          cell_indices = atoms(atom1_index)%subcell_indices
-          atom_cell = cell%subcells(cell_indices(1),cell_indices(2),cell_indices(3))
-          call wrapped_coordinates(atoms(atom1_index)%position,cell,dummy1,atom1_wrap_offset)
+  end subroutine core_get_kinetic_energy
 
-          do k_n = -1,1
-             do j_n = -1,1
-                do i_n = -1,1
-                   
-                   cell_indices(1:3) = atom_cell%neighbors(1:3,i_n,j_n,k_n)
 
-                   neighbor_cell = cell%subcells(cell_indices(1),cell_indices(2),cell_indices(3))
-                   neighbor_offset = atom_cell%offsets(1:3,i_n,j_n,k_n)
-                   neighbor_include = atom_cell%include(i_n,j_n,k_n)               
+! !!!: core_fire_relaxation
 
-                   if(neighbor_include)then
-                      
-                      do j = 1, neighbor_cell%n_atoms
-                         atom2_index = neighbor_cell%atoms(j)
-                         call wrapped_coordinates(atoms(atom2_index)%position,cell,dummy1,atom2_wrap_offset)
+  ! Minimizes the potential energy with respect to the positions of the atoms,
+  ! and optionally the shape of the supercell, using the fast inertial
+  ! relaxation engine (FIRE) of Bitzek et al., Phys. Rev. Lett. 97, 170201 (2006).
+  !
+  ! The steps are taken as in the FIRE optimizer of ASE: the atoms move as
+  ! particles of unit mass, and on each step the velocities are mixed with the
+  ! direction of the forces,
+  !
+  ! .. math::
+  !
+  !    \mathbf{v} \leftarrow (1-a) \mathbf{v} + a |\mathbf{v}| \hat{\mathbf{F}},
+  !
+  ! as long as the power :math:`\mathbf{F} \cdot \mathbf{v}` is positive. After ``n_min`` such steps
+  ! the time step is increased by the factor ``f_inc`` (up to ``max_timestep``) and :math:`a` is
+  ! decreased by ``f_a``. If the power is negative, the velocities are set to zero,
+  ! the time step is decreased by ``f_dec`` and :math:`a` is reset to ``a_start``. The
+  ! length of the step of the whole system is limited to ``max_move``.
+  ! The parameters are given in the array ``parameters`` in the order
+  ! ``timestep``, ``max_move``, ``max_timestep``, ``f_inc``, ``f_dec``, ``a_start``, ``f_a``.
+  !
+  ! If the cell is relaxed, the strain of the cell with respect to the initial cell
+  ! is included in the degrees of freedom as in the UnitCellFilter of ASE. The
+  ! generalized forces driving the strain components 
+  ! :math:`[\varepsilon_{xx},\varepsilon_{yy},\varepsilon_{zz},\gamma_{yz},\gamma_{xz},\gamma_{xy}]` 
+  ! are the components of the stress tensor multiplied by the volume (see :func:`core_calculate_forces`),
+  ! masked by ``cell_mask``. When the cell changes, the atoms keep their fractional coordinates.
+  ! The kinetic part of the stress is not included.
+  !
+  ! The relaxation stops when the largest force on an atom (or strain component)
+  ! is smaller than ``fmax``, or after ``max_steps`` steps.
+  ! Fixed atoms do not move, except as the cell is deformed.
+  !
+  ! The neighbor lists are rebuilt only if some pair of atoms may have come within 
+  ! the cutoff, taking into account both the displacements of the atoms
+  ! with respect to the deformation of the cell and the deformation itself.
+  !
+  ! called from PyInterface: :func:`run_fire_relaxation`
+  !
+  ! *max_steps the maximum number of steps
+  ! *fmax the convergence criterion for the forces
+  ! *parameters the parameters of the algorithm, as listed above
+  ! *n_min the number of steps with positive power before the time step is increased
+  ! *relax_cell true if also the cell is relaxed
+  ! *cell_mask the strain components which are relaxed
+  ! *cutoffs the cutoffs of the neighbor lists of the atoms, including the skin, in the order of atom indices
+  ! *skin the skin width of the neighbor lists
+  ! *fixed true for the atoms which do not move, in the order of atom indices
+  ! *record_energies true if the potential energy should be recorded on every step
+  ! *positions the positions of the atoms at the end, in the order of atom indices
+  ! *vectors the vectors spanning the cell at the end, as in :func:`core_create_cell`
+  ! *force_history the largest force on each step
+  ! *energy_history the potential energy on each step, if recorded
+  ! *n_steps the number of steps taken
+  ! *converged true if the forces were converged
+  ! *n_rebuilds the number of times the neighbor lists were rebuilt
+  subroutine core_fire_relaxation(max_steps,fmax,parameters,n_min,relax_cell,cell_mask,&
+       cutoffs,skin,fixed,record_energies,positions,vectors,force_history,energy_history,&
+       n_steps,converged,n_rebuilds)
+    implicit none
+    integer, intent(in) :: max_steps, n_min
+    double precision, intent(in) :: fmax, parameters(7), cutoffs(:), skin
+    logical, intent(in) :: relax_cell, cell_mask(6), fixed(:), record_energies
+    double precision, intent(out) :: positions(:,:), vectors(3,3), force_history(:), &
+         energy_history(:)
+    integer, intent(out) :: n_steps, n_rebuilds
+    logical, intent(out) :: converged
+    double precision, allocatable :: forces(:,:), velocities(:,:), steps(:,:)
+    double precision :: timestep, max_move, max_timestep, f_inc, f_dec, a_start, f_a, &
+         mixing, stress(6), power, largest_force, step_length, strain(6), &
+         original_vectors(3,3), deformation(3,3), build_inverse(3,3), relative(3), &
+         max_displacement, separation(3)
+    integer :: n_atoms, n_rows, i, k, n_positive
+    logical :: first_step
+
+    timestep = parameters(1)
+    max_move = parameters(2)
+    max_timestep = parameters(3)
+    f_inc = parameters(4)
+    f_dec = parameters(5)
+    a_start = parameters(6)
+    f_a = parameters(7)
+
+    ! The strain components are stored as two extra rows.
+    n_atoms = size(atoms)
+    n_rows = n_atoms
+    if(relax_cell)then
+       n_rows = n_atoms + 2
+    end if
+    allocate(forces(3,n_rows))
+    allocate(velocities(3,n_rows))
+    allocate(steps(3,n_rows))
+    velocities = 0.d0
+    strain = 0.d0
+    original_vectors = cell%vectors
+    build_inverse = cell%inverse_cell
+    mixing = a_start
+    n_positive = 0
+    first_step = .true.
+    converged = .false.
+    n_rebuilds = 0
+    n_steps = 0
+
+    do
+
+       ! forces in the order of atom indices
+       call core_calculate_forces(forces(1:3,1:n_atoms),stress)
+       call core_restore_atom_order_of_vectors(forces(1:3,1:n_atoms))
+       do i = 1, n_atoms
+          if(fixed(i))then
+             forces(1:3,i) = 0.d0
+          end if
+       end do
+       if(relax_cell)then
+          do k = 1, 3
+             forces(k,n_atoms+1) = merge(stress(k),0.d0,cell_mask(k))
+             forces(k,n_atoms+2) = merge(stress(k+3),0.d0,cell_mask(k+3))
+          end do
+       end if
 
-                         ! prevent double counting
-                         if(pick(atom1_index,atom2_index,neighbor_offset))then
-                            call separation_vector(atoms(atom1_index)%position, &
-                                 atoms(atom2_index)%position, &
-                                 neighbor_offset - atom1_wrap_offset + atom2_wrap_offset, &
-                                 cell, &
-                                 separation)
-                            ! distance squared
-                            distance = separation.o.separation
+       largest_force = 0.d0
+       do i = 1, n_rows
+          largest_force = max(largest_force, forces(1:3,i).o.forces(1:3,i))
+       end do
+       largest_force = sqrt(largest_force)
+       force_history(n_steps+1) = largest_force
+       if(record_energies)then
+          call core_calculate_energy(energy_history(n_steps+1))
+       end if
+       if(largest_force < fmax)then
+          converged = .true.
+          exit
+       end if
+       if(n_steps == max_steps)then
+          exit
+       end if
 
-                            ! atom2 is neighbor of atom1
-                            if(distance < cutoffs(atom1_index)*cutoffs(atom1_index))then
-                               n_nbs(atom1_index) = n_nbs(atom1_index)+1
-                               nbors_and_offsets(1,n_nbs(atom1_index),atom1_index) = atom2_index
-                               nbors_and_offsets(2:4,n_nbs(atom1_index),atom1_index) = neighbor_offset(1:3) &
-                                     - atom1_wrap_offset(1:3) + atom2_wrap_offset(1:3)
-                               if(n_nbs(atom1_index) == max_n_nbors)then
-                                  call expand_neighbor_storage(nbors_and_offsets,max_n_nbors,max_n_nbors+50,n_atoms)
-                                  max_n_nbors = max_n_nbors + 50
-                               end if
-                            end if
+       if(.not.first_step)then
+          power = sum(forces*velocities)
+          if(power > 0.d0)then
+             velocities = (1.d0-mixing)*velocities + &
+                  mixing*forces/sqrt(sum(forces*forces))*sqrt(sum(velocities*velocities))
+             if(n_positive > n_min)then
+                timestep = min(timestep*f_inc, max_timestep)
+                mixing = mixing*f_a
+             end if
+             n_positive = n_positive + 1
+          else
+             velocities = 0.d0
+             mixing = a_start
+             timestep = timestep*f_dec
+             n_positive = 0
+          end if
+       end if
+       first_step = .false.
 
-                            ! atom1 is neighbor of atom2
-                            if(distance < cutoffs(atom2_index)*cutoffs(atom2_index))then
-                               n_nbs(atom2_index) = n_nbs(atom2_index)+1
-                               nbors_and_offsets(1,n_nbs(atom2_index),atom2_index) = atom1_index
-                               nbors_and_offsets(2:4,n_nbs(atom2_index),atom2_index) = -neighbor_offset &
-                                     + atom1_wrap_offset(1:3) - atom2_wrap_offset(1:3)
-                               if(n_nbs(atom2_index) == max_n_nbors)then
-                                  call expand_neighbor_storage(nbors_and_offsets,max_n_nbors,max_n_nbors+50,n_atoms)
-                                  max_n_nbors = max_n_nbors + 50
-                               end if
-                            end if
+       velocities = velocities + timestep*forces
+       steps = timestep*velocities
+       step_length = sqrt(sum(steps*steps))
+       if(step_length > max_move)then
+          steps = max_move/step_length*steps
+       end if
 
-                         end if ! pick
+       do i = 1, n_atoms
+          atoms(i)%position = atoms(i)%position + steps(1:3,atoms(i)%index)
+       end do
 
-                      end do ! j = 1, neighbor_cell%n_atoms
-                      
-                   end if
-                   
-                end do
-             end do
+       if(relax_cell)then
+          ! The atoms keep their fractional coordinates as the cell is deformed.
+          do k = 1, 3
+             if(cell_mask(k))then
+                strain(k) = strain(k) + steps(k,n_atoms+1)
+             end if
+             if(cell_mask(k+3))then
+                strain(k+3) = strain(k+3) + steps(k,n_atoms+2)
+             end if
           end do
-          
-          
-       end if ! is_my_atom
-    end do ! atom1_index
-        
-#ifdef MPI
-
-    ! get the total array size by summing the neighbors found by all cpus
-    call mpi_allreduce(n_nbs,total_n_nbs,n_atoms,mpi_integer,mpi_sum,mpi_comm_world,mpistat)
-    tmp_max = max(max_n_nbors, maxval(total_n_nbs))
-    ! get the maximum array size (in case some array expanded during search)
-    call mpi_allreduce(tmp_max,global_max,1,mpi_integer,mpi_max,mpi_comm_world,mpistat)
-    if(global_max > max_n_nbors)then
-       call expand_neighbor_storage(nbors_and_offsets,max_n_nbors,global_max,n_atoms)
-       max_n_nbors = global_max
-    end if
+          deformation(1,1:3) = (/ 1.d0 + strain(1), 0.5d0*strain(6), 0.5d0*strain(5) /)
+          deformation(2,1:3) = (/ 0.5d0*strain(6), 1.d0 + strain(2), 0.5d0*strain(4) /)
+          deformation(3,1:3) = (/ 0.5d0*strain(5), 0.5d0*strain(4), 1.d0 + strain(3) /)
+          do i = 1, n_atoms
+             call relative_coordinates(atoms(i)%position,cell,relative) ! in Geometry.f90
+             atoms(i)%position = matmul(matmul(deformation,original_vectors),relative)
+          end do
+          call deform_supercell(matmul(deformation,original_vectors),cell) ! in Geometry.f90
+       end if
 
-    ! stack the lists on cpu 0 and broadcast them to all cpus
-    call mpi_stack(nbors_and_offsets,n_nbs,4,n_atoms,max_n_nbors)
-    call mpi_bcast(nbors_and_offsets,4*n_atoms*max_n_nbors,mpi_integer,0,mpi_comm_world,mpistat)
-    call mpi_bcast(n_nbs,n_atoms,mpi_integer,0,mpi_comm_world,mpistat)
+       ! The separation of two listed atoms changes at most by the sum of their
+       ! displacements with respect to the deformation of the cell since the lists
+       ! were built, plus the deformation times the separation.
+       ! So, the lists remain valid while twice the largest displacement plus
+       ! the deformation times the list cutoff is smaller than the skin.
+       deformation = matmul(cell%vectors,build_inverse)
+       max_displacement = 0.d0
+       do i = 1, n_atoms
+          separation = atoms(i)%position - matmul(deformation,neighbor_reference_positions(1:3,i))
+          max_displacement = max(max_displacement, separation.o.separation)
+       end do
+       do k = 1, 3
+          deformation(k,k) = deformation(k,k) - 1.d0
+       end do
+       if(2.d0*sqrt(max_displacement) + sqrt(sum(deformation*deformation))*maxval(cutoffs) > skin)then
+          call core_create_space_partitioning(maxval(cutoffs))
+          call core_build_neighbor_lists(cutoffs,skin)
+          build_inverse = cell%inverse_cell
+          n_rebuilds = n_rebuilds + 1
+       end if
 
+       n_steps = n_steps + 1
 
-#endif
+    end do
 
-    do atom1_index = 1, n_atoms
-       call core_create_neighbor_list(n_nbs(atom1_index),atom1_index,&
-            nbors_and_offsets(1,1:n_nbs(atom1_index),atom1_index),&
-            nbors_and_offsets(2:4,1:n_nbs(atom1_index),atom1_index))
+    do i = 1, n_atoms
+       positions(1:3,atoms(i)%index) = atoms(i)%position
     end do
+    vectors = cell%vectors
 
-  end subroutine core_build_neighbor_lists
+    deallocate(forces)
+    deallocate(velocities)
+    deallocate(steps)
+
+  end subroutine core_fire_relaxation
 
 
   ! Expands the allocated memory for storing neighbor lists
@@ -8330,6 +11433,62 @@ contains
   end subroutine core_get_neighbor_list_of_atom
 
 
+  ! Returns the total number of neighbors summed over all atoms,
+  ! i.e., the number of atom pairs stored in the neighbor lists.
+  ! Since the lists are built both ways, every pair is counted twice.
+  !
+  ! *n_pairs the total number of neighbors
+  subroutine core_get_total_number_of_neighbors(n_pairs)
+    implicit none
+    integer, intent(out) :: n_pairs
+    integer :: i
+
+    n_pairs = 0
+    if(atoms_created)then
+       do i = 1, size(atoms)
+          n_pairs = n_pairs + atoms(i)%neighbor_list%n_neighbors
+       end do
+    end if
+
+  end subroutine core_get_total_number_of_neighbors
+
+
+  ! Returns the neighbor lists of all atoms packed in
+  ! compressed sparse row (CSR) format.
+  ! The lists and the neighbors are given in the order of atom indices,
+  ! even if the atoms are stored in a different order in the core.
+  ! The neighbors of atom i are stored in the
+  ! slots ``pointers(i)+1 ... pointers(i+1)`` of the arrays
+  ! neighbors and offsets, so that ``pointers(1) = 0`` and
+  ! ``pointers(n_atoms+1) = n_pairs``.
+  !
+  ! *n_atoms the number of atoms
+  ! *n_pairs the total number of neighbors, see :func:`core_get_total_number_of_neighbors`
+  ! *pointers the positions in the packed arrays where the list of each atom starts
+  ! *neighbors the indices of the neighboring atoms, for all atoms
+  ! *offsets the offsets for periodic boundaries, for all atoms
+  subroutine core_get_all_neighbor_lists(n_atoms, n_pairs, pointers, neighbors, offsets)
+    implicit none
+    integer, intent(in) :: n_atoms, n_pairs
+    integer, intent(out) :: pointers(n_atoms+1), neighbors(n_pairs), offsets(3,n_pairs)
+    integer :: i, index, n_nbors, start
+
+    start = 0
+    pointers(1) = 0
+    do index = 1, n_atoms
+       i = atom_storage_index(index)
+       n_nbors = atoms(i)%neighbor_list%n_neighbors
+       if(n_nbors > 0)then
+          neighbors(start+1:start+n_nbors) = atoms(atoms(i)%neighbor_list%neighbors(1:n_nbors))%index
+          offsets(1:3,start+1:start+n_nbors) = atoms(i)%neighbor_list%pbc_offsets(1:3,1:n_nbors)
+       end if
+       start = start + n_nbors
+       pointers(index+1) = start
+    end do
+
+  end subroutine core_get_all_neighbor_lists
+
+
   ! Write atomic coordinates and other info in a file.
   ! This is only for debugging.
   subroutine core_debug_dump(forces)
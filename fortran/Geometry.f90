@@ -8,6 +8,8 @@ module geometry
 
   ! *label_length the number of characters available for denoting chemical symbols
   integer, parameter :: label_length = 2
+  ! *sparse_subcell_ratio if there are more subcells than this number times the number of atoms, only the occupied subcells are stored, in a hash table
+  integer, parameter :: sparse_subcell_ratio = 4
 
   ! Defines a list of neighbors for a single atom.
   ! The list contains the indices of the neighboring atoms
@@ -47,9 +49,12 @@ module geometry
   ! *pbc_offsets offsets for periodic boundaries for each neighbor
   ! *max_length The allocated length of the neighbor lists. To avoid deallocating and reallocating memory, extra space is reserved for the neighbors in case the number of neighbors increases during simulation (due to atoms moving).
   ! *n_neighbors the number of neighbors in the lists
+  ! *tier_radii the cutoffs of the tiers of the list (see :func:`divide_neighbor_list_in_tiers`), negative if the list is not divided in tiers
+  ! *tier_ends the number of neighbors at the beginning of the list which may be within the cutoffs of the tiers
   type neighbor_list
      integer, pointer :: neighbors(:), pbc_offsets(:,:)
-     integer :: max_length, n_neighbors
+     integer :: max_length, n_neighbors, tier_ends(2)
+     double precision :: tier_radii(2)
   end type neighbor_list
 
   ! Defines an atomic particle.
@@ -58,7 +63,7 @@ module geometry
   ! *charge charge of the atom
   ! *position coordinates of the atom
   ! *momentum momentum of the atom
-  ! *index index of the atom
+  ! *index index of the atom in the order the atoms were given to the core (the atoms may be stored in a different order, see :func:`core_order_atoms_along_curve`)
   ! *tags integer tag
   ! *n_pots number of potentials that may affect the atom
   ! *n_bonds number of bond order factors that may affect the atom
@@ -68,7 +73,7 @@ module geometry
   ! *neighbor_list the list of neighbors for the atom
   ! *potential_indices the indices of the potentials for which this atom is a valid target at first position (see :func:`potential_affects_atom`)
   ! *bond_indices the indices of the bond order factors for which this atom is a valid target at first position (see :func:`bond_order_factor_affects_atom`)
-  ! *subcell_indices indices of the subcell containing the atom, used for fast neighbor searching (see :data:`subcell`)
+  ! *subcell_indices indices of the subcell containing the atom, used for fast neighbor searching (see :func:`divide_cell`)
   ! *max_potential_radius the maximum cutoff of any potential listed in potential_indices
   ! *max_bond_radius the maximum cutoff of any bond order factor listed in bond_indices
   type atom
@@ -105,45 +110,27 @@ module geometry
   ! *volume volume of the cell
   ! *periodic logical switch determining if periodic boundary conditions are applied in the directions of the three cell spanning vectors
   ! *n_splits the number of subcells there are in the subdivisioning of the cell, in the directions of the spanning vectors
-  ! *max_subcell_atom_count the maximum number of atoms any of the subcells has
-  ! *subcells an array of :data:`subcell` subvolumes which partition the supercell
+  ! *n_subcells the total number of subcells, including the padding subcells (see :func:`divide_cell`)
+  ! *n_occupied_subcells the number of subcells containing atoms
+  ! *sparse_subcells logical switch, true if only the occupied subcells are stored in a hash table, false if all subcells are stored
+  ! *subcell_first the atoms of the subcell stored in slot i are subcell_atoms(subcell_first(i):subcell_first(i+1)-1)
+  ! *subcell_atoms the indices of atoms, ordered by subcell
+  ! *occupied_subcells the slots of the subcells containing atoms
+  ! *subcell_keys the keys (see :func:`subcell_key`) of the subcells stored in the slots, only used for sparse storage
+  ! *subcell_hash the hash table of slots for sparse storage, 0 for empty entries
   type supercell
      double precision :: vectors(3,3), inverse_cell(3,3), &
         reciprocal_cell(3,3),vector_lengths(3), volume
      logical :: periodic(3)
-     integer :: n_splits(3), max_subcell_atom_count
-     type(subcell), pointer :: subcells(:,:,:)
+     integer :: n_splits(3), n_occupied_subcells
+     integer(kind=8) :: n_subcells
+     logical :: sparse_subcells
+     integer, pointer :: subcell_first(:), subcell_atoms(:), occupied_subcells(:), &
+          subcell_hash(:)
+     integer(kind=8), pointer :: subcell_keys(:)
   end type supercell
 
 
-  ! Subvolume, which is a part of the supercell containing the simulation.
-  ! 
-  ! The subcells are used in partitioning of the simulation space in subvolumes.
-  ! This divisioning of the simulation cell is needed for quickly finding the 
-  ! neighbors of atoms (see also :class:`pysic.FastNeighborList`).
-  ! The fast neighbor search is based on dividing the system, locating the subcell
-  ! in which each atom is located, and then searching for neighbors for each atom
-  ! by only checking the adjacent subcells. For small subvolumes (short cutoffs)
-  ! this method is much faster than a brute force algorithm that checks all atom
-  ! pairs. It also scales :math:`\mathcal{O}(n)`.
-  !
-  ! *indices integer coordinates of the subcell in the subcell divisioning of the supercell
-  ! *offsets integer offsets of the neighboring subcells - if a neighboring subcell is beyond a periodic border, the offset records the fact
-  ! *n_atoms the number of atoms contained by the subcell
-  ! *max_atoms the maximum number of atoms the cell can contain in the currently allocated memory space
-  ! *vectors the vectors spanning the subcell
-  ! *vector_lengths lengths of the vectors spanning the subcell
-  ! *neighbors indices of the 3 x 3 x 3 neighboring subcells (note that the neighboring subcell 0,0,0 is the cell itself)
-  ! *atoms indices of the atoms in this subcell
-  ! *include A logical array noting if the neighboring subcells should be included in the neighbor search. Usually all neighbors are included, but in a non-periodic system, there is only a limited number of cells and once the system border is reached, this tag will be set to ``.false.`` to notify that there is no neighbor to be found.
-  type subcell
-     integer :: indices(3), offsets(3,-1:1,-1:1,-1:1), n_atoms, max_atoms
-     double precision :: vectors(3,3), vector_lengths(3)
-     integer :: neighbors(3,-1:1,-1:1,-1:1)
-     integer, pointer :: atoms(:)
-     logical :: include(-1:1,-1:1,-1:1)
-  end type subcell
-
 contains
 
   ! Creates the supercell containing the simulation geometry.
@@ -190,11 +177,50 @@ contains
     end do
     cell%volume = abs( (vectors(1:3,1).x.vectors(1:3,2)).o.vectors(1:3,3) )
     cell%n_splits = 0
-    nullify(cell%subcells)
+    cell%n_subcells = 0
+    cell%n_occupied_subcells = 0
+    cell%sparse_subcells = .false.
+    nullify(cell%subcell_first)
+    nullify(cell%subcell_atoms)
+    nullify(cell%occupied_subcells)
+    nullify(cell%subcell_hash)
+    nullify(cell%subcell_keys)
 
   end subroutine generate_supercell
 
 
+  ! Changes the vectors spanning an existing supercell.
+  !
+  ! The inverse cell is calculated from the new vectors, and
+  ! the reciprocal cell, the lengths of the vectors and the volume are updated.
+  ! The periodicity is kept, but the subcells are not updated, so the
+  ! cell must be divided again with :func:`divide_cell` before searching for neighbors.
+  ! Unlike :func:`generate_supercell`, this does not lose the memory
+  ! allocated for the subcells.
+  !
+  ! *vectors the new cell spanning matrix :math:`\mathbf{M}`
+  ! *cell the deformed cell
+  subroutine deform_supercell(vectors,cell)
+    implicit none
+    double precision, intent(in) :: vectors(3,3)
+    type(supercell), intent(inout) :: cell
+    double precision :: volume
+    integer :: i
+
+    volume = (vectors(1:3,1).x.vectors(1:3,2)).o.vectors(1:3,3)
+    cell%vectors = vectors
+    cell%inverse_cell(1,1:3) = (vectors(1:3,2).x.vectors(1:3,3)) / volume
+    cell%inverse_cell(2,1:3) = (vectors(1:3,3).x.vectors(1:3,1)) / volume
+    cell%inverse_cell(3,1:3) = (vectors(1:3,1).x.vectors(1:3,2)) / volume
+    cell%reciprocal_cell = 2*pi*transpose(cell%inverse_cell)
+    do i = 1, 3
+       cell%vector_lengths(i) = (.norm.vectors(1:3,i))
+    end do
+    cell%volume = abs(volume)
+
+  end subroutine deform_supercell
+
+
 
   ! Creates atoms to construct the system to be simulated.
   !
@@ -228,6 +254,8 @@ contains
        atoms(i)%index = i
        atoms(i)%neighbor_list%max_length = 0
        atoms(i)%neighbor_list%n_neighbors = 0
+       atoms(i)%neighbor_list%tier_ends = 0
+       atoms(i)%neighbor_list%tier_radii = -1.d0
        nullify(atoms(i)%neighbor_list%neighbors)
        nullify(atoms(i)%neighbor_list%pbc_offsets)
        atoms(i)%n_pots = 0
@@ -244,7 +272,7 @@ contains
 
 
 
-  ! Updates the positions and momenta of the given atoms.
+  ! Updates the positions of the given atoms.
   ! Other properties are not altered. 
   !
   ! This is meant to be used
@@ -253,27 +281,51 @@ contains
   !
   ! *n_atoms number of atoms
   ! *positions new coordinates for the atoms
-  ! *momenta new momenta for the atoms
   ! *atoms the atoms to be edited
-  subroutine update_atomic_positions(n_atoms,positions,momenta,atoms)
+  subroutine update_atomic_positions(n_atoms,positions,atoms)
     implicit none
     integer, intent(in) :: n_atoms
-    double precision, intent(in) :: positions(3,n_atoms), momenta(3,n_atoms)
+    double precision, intent(in) :: positions(3,n_atoms)
     type(atom), pointer :: atoms(:)
     integer :: i
 
     if(size(atoms) /= n_atoms)then
        write(*,*) "the number of atoms has changed, you should reinitialize the structure"
     else
+       ! the atoms may be stored in a different order than given,
+       ! so the data is picked by the index of each atom
        do i = 1, n_atoms
-          atoms(i)%position(1:3) = positions(1:3,i)
-          atoms(i)%momentum(1:3) = momenta(1:3,i)
+          atoms(i)%position(1:3) = positions(1:3,atoms(i)%index)
        end do
     end if
 
   end subroutine update_atomic_positions
 
 
+  ! Updates the momenta of the given atoms.
+  ! Other properties are not altered. 
+  !
+  ! *n_atoms number of atoms
+  ! *momenta new momenta for the atoms
+  ! *atoms the atoms to be edited
+  subroutine update_atomic_momenta(n_atoms,momenta,atoms)
+    implicit none
+    integer, intent(in) :: n_atoms
+    double precision, intent(in) :: momenta(3,n_atoms)
+    type(atom), pointer :: atoms(:)
+    integer :: i
+
+    if(size(atoms) /= n_atoms)then
+       write(*,*) "the number of atoms has changed, you should reinitialize the structure"
+    else
+       do i = 1, n_atoms
+          atoms(i)%momentum(1:3) = momenta(1:3,atoms(i)%index)
+       end do
+    end if
+
+  end subroutine update_atomic_momenta
+
+
 
   ! Updates the charges of the given atoms.
   ! Other properties are not altered. 
@@ -292,7 +344,7 @@ contains
        write(*,*) "the number of atoms has changed, you should reinitialize the structure"
     else
        do i = 1, n_atoms
-          atoms(i)%charge = charges(i)
+          atoms(i)%charge = charges(atoms(i)%index)
        end do
     end if
 
@@ -340,6 +392,8 @@ contains
     nbor_list%neighbors = -1
     nbor_list%pbc_offsets = 0
     nbor_list%n_neighbors = n_nbs
+    nbor_list%tier_ends = n_nbs
+    nbor_list%tier_radii = -1.d0
     if(n_nbs > 0)then
        nbor_list%neighbors(1:n_nbs) = neighbors(1:n_nbs)
        nbor_list%pbc_offsets(1:3,1:n_nbs) = offsets(1:3,1:n_nbs)
@@ -347,6 +401,107 @@ contains
 
   end subroutine assign_neighbor_list
 
+
+  ! Divides a neighbor list in tiers according to the distances of the neighbors.
+  !
+  ! A neighbor list must contain all the atoms within the longest cutoff
+  ! of any interaction of the atom, such as the real space cutoff of Ewald summation,
+  ! but many interactions, especially the many-body ones, have much shorter cutoffs.
+  ! Therefore the list is reordered so that the neighbors which may be within
+  ! the shorter of the given cutoffs are first, followed by the neighbors
+  ! which may be within the longer cutoff, and then the rest.
+  ! The relative order of the neighbors in each tier is preserved.
+  ! Loops over neighbors that only need the neighbors within one of the cutoffs
+  ! can then be cut short, see :func:`neighbors_within`.
+  !
+  ! The distances must be the ones at the time the list was built. 
+  ! Since the list is rebuilt before any pair of atoms has moved closer to each other
+  ! by more than the skin width, the neighbors within a cutoff are always 
+  ! found among those that were within the cutoff plus skin.
+  !
+  ! *nbor_list the neighbor list
+  ! *distances the distances to the neighbors when the list was built
+  ! *radii the two cutoffs dividing the list
+  ! *skin the skin width of the list
+  subroutine divide_neighbor_list_in_tiers(nbor_list,distances,radii,skin)
+    implicit none
+    type(neighbor_list), intent(inout) :: nbor_list
+    double precision, intent(in) :: distances(:), radii(2), skin
+    integer :: n_nbs, j, tier, first, second, counts(3), slots(3)
+    integer, allocatable :: tiers(:), tmp_nbors(:), tmp_offsets(:,:)
+
+    n_nbs = nbor_list%n_neighbors
+    if(radii(1) <= radii(2))then
+       first = 1
+       second = 2
+    else
+       first = 2
+       second = 1
+    end if
+
+    allocate(tiers(n_nbs))
+    counts = 0
+    do j = 1, n_nbs
+       if(distances(j) < radii(first)+skin)then
+          tier = 1
+       else if(distances(j) < radii(second)+skin)then
+          tier = 2
+       else
+          tier = 3
+       end if
+       tiers(j) = tier
+       counts(tier) = counts(tier) + 1
+    end do
+
+    if(counts(1) /= n_nbs .and. counts(2) /= n_nbs .and. counts(3) /= n_nbs)then
+       allocate(tmp_nbors(n_nbs))
+       allocate(tmp_offsets(3,n_nbs))
+       tmp_nbors = nbor_list%neighbors(1:n_nbs)
+       tmp_offsets = nbor_list%pbc_offsets(1:3,1:n_nbs)
+       slots(1) = 0
+       slots(2) = counts(1)
+       slots(3) = counts(1) + counts(2)
+       do j = 1, n_nbs
+          slots(tiers(j)) = slots(tiers(j)) + 1
+          nbor_list%neighbors(slots(tiers(j))) = tmp_nbors(j)
+          nbor_list%pbc_offsets(1:3,slots(tiers(j))) = tmp_offsets(1:3,j)
+       end do
+       deallocate(tmp_nbors)
+       deallocate(tmp_offsets)
+    end if
+    deallocate(tiers)
+
+    nbor_list%tier_radii = radii
+    nbor_list%tier_ends(first) = counts(1)
+    nbor_list%tier_ends(second) = counts(1) + counts(2)
+
+  end subroutine divide_neighbor_list_in_tiers
+
+
+  ! Returns the number of neighbors at the beginning of a neighbor list
+  ! among which all the neighbors within the given distance are found.
+  ! If the list has been divided in tiers with :func:`divide_neighbor_list_in_tiers`
+  ! and the distance is within the cutoff of a tier, this is the end of the tier.
+  ! Otherwise, it is the length of the whole list.
+  !
+  ! *nbor_list the neighbor list
+  ! *radius the distance
+  function neighbors_within(nbor_list,radius)
+    implicit none
+    integer :: neighbors_within
+    type(neighbor_list), intent(in) :: nbor_list
+    double precision, intent(in) :: radius
+    integer :: tier
+
+    neighbors_within = nbor_list%n_neighbors
+    do tier = 1, 2
+       if(radius <= nbor_list%tier_radii(tier))then
+          neighbors_within = min(neighbors_within, nbor_list%tier_ends(tier))
+       end if
+    end do
+
+  end function neighbors_within
+
   ! Save the indices of potentials affecting an atom.
   !
   ! In force and energy evaluation, it is important to loop
@@ -676,6 +831,15 @@ contains
   end function pick
   
 
+  ! Finds the number of subcells along each cell vector so that
+  ! the subcells are at least as wide as the given cutoff.
+  ! The number of subcells is not limited: the memory needed for
+  ! the partitioning is bounded by the number of atoms, since
+  ! sparse grids are stored in a hash table (see :func:`assign_atoms_to_subcells`).
+  !
+  ! *cell the supercell
+  ! *max_cut the cutoff, i.e., the minimum width of the subcells
+  ! *splits the number of subcells along each cell vector
   subroutine get_optimal_splitting(cell,max_cut,splits)
     implicit none
     type(supercell), intent(in) :: cell
@@ -698,9 +862,7 @@ contains
        else
           splits(i) = int( floor( length/max_cut ) )
        end if
-       ! do not split more than 40 times, otherwise we may end up using an enormous 
-       ! amount of memory (100**3 = 1000000...)
-       splits(i) = min(40, splits(i))
+       splits(i) = max(1, splits(i))
 
     end do
 
@@ -712,182 +874,194 @@ contains
   ! The argument 'splits' should be a list of three integers determining how many
   ! times the cell is split. For instance, if splits = [3,3,5], the cell is divided in
   ! 3*3*5 = 45 subcells: 3 cells along the first two cell vectors and 5 along the third.
-  ! 
-  ! The Cell itself is not changed, but an array 'subcells' is created, containing
-  ! the subcells which are Cell instances themselves. These cells will contain additional
-  ! data arrays 'neighbors' and 'offsets'. These are 3-dimensional arrays with each dimension
-  ! running from -1 to 1. The neighbors array contains references to the neighboring subcell
-  ! Cell instances.
-  ! The offsets contain coordinate offsets with respect to the periodic boundaries. In other words,
-  ! if a subcell is at the border of the original Cell, it will have neighbors at the other side
-  ! of the cell due to periodic boundary conditions. But from the point of view of the subcell,
-  ! the neighboring cell is not on the other side of the master cell, but a periodic image of that
-  ! cell. Therefore, any coordinates in the the subcell to which the neighbors array refers to must
-  ! in fact be shifted by a vector of the master cell. The offsets list contains the multipliers
-  ! for the cell vectors to make these shifts.
-  !
-  ! Example in 2D for simplicity: ``split = [3,4]`` creates subcells::
-  !
-  !  (0,3) (1,3) (2,3)
-  !  (0,2) (1,2) (2,2)
-  !  (0,1) (1,1) (2,1)
-  !  (0,0) (1,0) (2,0)
-  ! 
-  ! subcell (0,3) will have the neighbors::
-  !  (2,0) (0,0) (1,0)
-  !  (2,3) (0,3) (1,3)
-  !  (2,2) (0,2) (1,2)
-  !
-  ! and offsets::
-  !  [-1,1] [0,1] [0,1]
-  !  [-1,0] [0,0] [0,0]
-  !  [-1,0] [0,0] [0,0]
-  !
-  ! Note that the central 'neighbor' is the cell itself.
+  ! The subcells are identified by their integer coordinates (indices) in this grid.
   !
   ! If a boundary is not periodic, extra subcells with indices 0 and split+1
   ! are created to pad the simulation cell. These will contain the atoms that
-  ! are outside the simulation cell.
+  ! are outside the simulation cell. For simplicity, the padding subcells
+  ! are included also in the periodic directions, where they remain empty.
+  ! 
+  ! This routine only defines the grid and releases the previous partitioning.
+  ! The atoms are sorted in the subcells by :func:`assign_atoms_to_subcells`.
+  ! The neighboring subcells are found with :func:`get_neighbor_subcell`.
+  ! 
+  ! *cell the supercell
+  ! *splits the number of subcells along each cell vector
   subroutine divide_cell(cell,splits)
     implicit none
     type(supercell), intent(inout) :: cell
     integer, intent(in) :: splits(3)
-    double precision :: new_vecs(3,3), new_lengths(3)
-    integer :: i,j,k, i_n,j_n,k_n, nbor_index(3), axis, offsets(3)
 
-    if(cell%n_splits(1) == 0)then
-       ! let every subcell have the initial capacity to store 20 atoms
-       cell%max_subcell_atom_count = 20
-       nullify(cell%subcells)
-    else
-       cell%max_subcell_atom_count = 20
-       do k = 0, splits(3)+1
-          do j = 0, splits(2)+1
-             do i = 0, splits(1)+1
-                if(cell%subcells(i,j,k)%max_atoms > 0)then
-                   cell%max_subcell_atom_count = max(cell%max_subcell_atom_count,cell%subcells(i,j,k)%max_atoms)
-                   deallocate(cell%subcells(i,j,k)%atoms)
-                else
-                   nullify(cell%subcells(i,j,k)%atoms)
-                end if
-             end do
-          end do
-       end do
-       deallocate(cell%subcells)
+    if(associated(cell%subcell_first))then
+       deallocate(cell%subcell_first)
+       deallocate(cell%subcell_atoms)
+       deallocate(cell%occupied_subcells)
+    end if
+    if(associated(cell%subcell_hash))then
+       deallocate(cell%subcell_hash)
+       deallocate(cell%subcell_keys)
     end if
-    allocate(cell%subcells(0:splits(1)+1,0:splits(2)+1,0:splits(3)+1))
+    nullify(cell%subcell_first)
+    nullify(cell%subcell_atoms)
+    nullify(cell%occupied_subcells)
+    nullify(cell%subcell_hash)
+    nullify(cell%subcell_keys)
 
     cell%n_splits = splits
+    cell%n_subcells = int(splits(1)+2,8) * int(splits(2)+2,8) * int(splits(3)+2,8)
+    cell%n_occupied_subcells = 0
+    cell%sparse_subcells = .false.
 
-    ! the vectors spanning the subcells
-    do i = 1,3
-       new_vecs(1:3,i) = cell%vectors(1:3,i)/splits(i)
-       new_lengths(i) = .norm.new_vecs(1:3,i)
-    end do
-    
-    ! create subcells
-    do k = 0, splits(3)+1
-       do j = 0, splits(2)+1
-          do i = 0, splits(1)+1
-
-             cell%subcells(i,j,k)%indices = (/ i,j,k /)
-             cell%subcells(i,j,k)%vectors = new_vecs
-             cell%subcells(i,j,k)%vector_lengths = new_lengths
-             allocate(cell%subcells(i,j,k)%atoms(cell%max_subcell_atom_count))
-             cell%subcells(i,j,k)%atoms = -1
-             cell%subcells(i,j,k)%n_atoms = 0
-             cell%subcells(i,j,k)%max_atoms = cell%max_subcell_atom_count
-
-          end do
-       end do
-    end do
-
-
-    ! find neighbors of subcells
-    do k = 0, splits(3)+1
-       do j = 0, splits(2)+1
-          do i = 0, splits(1)+1
-
-             cell%subcells(i,j,k)%include = .true.
-
-             ! loop over neighbors
-             do k_n = -1,1
-                do j_n = -1,1
-                   do i_n = -1,1
+  end subroutine divide_cell
 
-                      ! plain neighbor indices
-                      nbor_index(1) = i+i_n
-                      nbor_index(2) = j+j_n
-                      nbor_index(3) = k+k_n
 
-                      ! initialize offsets and including/excluding tags
-                      offsets = 0
+  ! Returns the key of a subcell, which is its running index in the grid
+  ! of subcells (including the padding subcells).
+  !
+  ! *cell the supercell
+  ! *indices the indices of the subcell, each between 0 and the number of splits + 1
+  function subcell_key(cell,indices)
+    implicit none
+    integer(kind=8) :: subcell_key
+    type(supercell), intent(in) :: cell
+    integer, intent(in) :: indices(3)
 
-                      ! loop over three directions and check for periodicity
-                      do axis = 1,3
+    subcell_key = 1_8 + indices(1) + int(cell%n_splits(1)+2,8) * &
+         ( indices(2) + int(cell%n_splits(2)+2,8) * indices(3) )
 
-                         if(cell%periodic(axis))then
+  end function subcell_key
 
-                            do while(nbor_index(axis) > splits(axis))
-                               nbor_index(axis) = nbor_index(axis) - splits(axis)
-                               offsets(axis) = offsets(axis) + 1
-                            end do
-                            do while(nbor_index(axis) < 1)
-                               nbor_index(axis) = nbor_index(axis) + splits(axis)
-                               offsets(axis) = offsets(axis) - 1
-                            end do
 
-                         else
+  ! Returns the Morton key of a subcell, obtained by interleaving the bits
+  ! of its indices. Ordering the subcells by their Morton keys traces a 
+  ! space-filling Z-order curve through the grid, so that subcells close to
+  ! each other in the ordering are also close to each other in space.
+  !
+  ! *indices the indices of the subcell, each between 0 and the number of splits + 1
+  ! *n_bits the number of bits needed for representing the indices (at most 21)
+  function subcell_morton_key(indices,n_bits)
+    implicit none
+    integer(kind=8) :: subcell_morton_key
+    integer, intent(in) :: indices(3), n_bits
+    integer :: bit, axis
+
+    subcell_morton_key = 0_8
+    do bit = 0, n_bits-1
+       do axis = 1, 3
+          if(btest(indices(axis),bit))then
+             subcell_morton_key = ibset(subcell_morton_key,3*bit+axis-1)
+          end if
+       end do
+    end do
 
-                            ! if not periodic, make a note if the neighboring cell is non-existent
-                            ! (out of bounds)
-                            if(nbor_index(axis) < 0 .or. nbor_index(axis) > splits(axis)+1)then
-                               cell%subcells(i,j,k)%include(i_n,j_n,k_n) = .false.
-                               nbor_index(axis) = 0
-                            end if
+  end function subcell_morton_key
 
-                         end if
 
-                      end do ! do axis = 1, 3
-                      
-                      ! store indices to the adjacent subcells
-                      cell%subcells(i,j,k)%neighbors(1:3,i_n,j_n,k_n) = nbor_index(1:3)
-                      cell%subcells(i,j,k)%offsets(1:3,i_n,j_n,k_n) = offsets(1:3)
+  ! Returns the slot in which the given subcell is stored.
+  ! For dense storage, the slot is the key of the subcell.
+  ! For sparse storage, the slot is found from the hash table and
+  ! 0 is returned for empty subcells.
+  !
+  ! *cell the supercell
+  ! *indices the indices of the subcell
+  function subcell_slot(cell,indices)
+    implicit none
+    integer :: subcell_slot
+    type(supercell), intent(in) :: cell
+    integer, intent(in) :: indices(3)
+    integer :: slot, position, table_size
+    integer(kind=8) :: key
 
-                   end do
-                end do
-             end do
+    key = subcell_key(cell,indices)
+    if(.not.cell%sparse_subcells)then
+       subcell_slot = int(key)
+       return
+    end if
 
-          end do
-       end do
+    ! linear probing of the hash table
+    table_size = size(cell%subcell_hash)
+    position = int(modulo(key,int(table_size,8))) + 1
+    do
+       slot = cell%subcell_hash(position)
+       if(slot == 0)then
+          exit
+       end if
+       if(cell%subcell_keys(slot) == key)then
+          exit
+       end if
+       position = mod(position,table_size) + 1
     end do
+    subcell_slot = slot
 
-  end subroutine divide_cell
+  end function subcell_slot
 
 
-  subroutine expand_subcell_atom_capacity(atoms_list,old_size,new_size)
+  ! Finds a subcell adjacent to the given one.
+  !
+  ! In periodic directions, the neighbors wrap around the cell and the
+  ! offsets record how many times the cell vectors must be added to the
+  ! coordinates in the neighbor to find the image next to the original subcell.
+  ! For instance, in 2D, the subcell (1,4) of a 3 x 4 grid has the neighbor (1,1)
+  ! in the direction (0,1) with the offset (0,1).
+  ! If the grid has less than three subcells in a periodic direction, the same
+  ! subcell is found several times, but with different offsets.
+  ! In directions that are not periodic, there are no neighbors beyond the padding
+  ! subcells, and this is marked by include = .false.
+  !
+  ! *cell the supercell
+  ! *indices the indices of the subcell
+  ! *direction the direction of the neighbor, each component -1, 0 or 1
+  ! *nbor_indices the indices of the neighboring subcell
+  ! *offsets the periodic offsets of the neighboring subcell
+  ! *include true if the neighboring subcell exists
+  subroutine get_neighbor_subcell(cell,indices,direction,nbor_indices,offsets,include)
     implicit none
-    integer, pointer :: atoms_list(:)
-    integer, intent(in) :: new_size, old_size
-    integer :: tmp_list(old_size)
+    type(supercell), intent(in) :: cell
+    integer, intent(in) :: indices(3), direction(3)
+    integer, intent(out) :: nbor_indices(3), offsets(3)
+    logical, intent(out) :: include
+    integer :: axis, splits
+
+    nbor_indices = indices + direction
+    offsets = 0
+    include = .true.
+
+    do axis = 1,3
+       splits = cell%n_splits(axis)
+       if(cell%periodic(axis))then
+
+          do while(nbor_indices(axis) > splits)
+             nbor_indices(axis) = nbor_indices(axis) - splits
+             offsets(axis) = offsets(axis) + 1
+          end do
+          do while(nbor_indices(axis) < 1)
+             nbor_indices(axis) = nbor_indices(axis) + splits
+             offsets(axis) = offsets(axis) - 1
+          end do
+
+       else
 
-    tmp_list(1:old_size) = atoms_list(1:old_size)
-    deallocate(atoms_list)
-    allocate(atoms_list(new_size))
-    atoms_list = -1
-    atoms_list(1:old_size) = tmp_list(1:old_size)
+          if(nbor_indices(axis) < 0 .or. nbor_indices(axis) > splits+1)then
+             include = .false.
+             nbor_indices(axis) = 0
+          end if
 
-  end subroutine expand_subcell_atom_capacity
+       end if
+    end do
 
+  end subroutine get_neighbor_subcell
 
 
+  ! Finds the subcell containing the given atom and stores its indices in the atom.
+  !
+  ! *cell the supercell
+  ! *at the atom
   subroutine find_subcell_for_atom(cell,at)
     implicit none
-    type(supercell), intent(inout) :: cell
+    type(supercell), intent(in) :: cell
     type(atom), intent(inout) :: at
-    double precision :: wrapped(3), fractional(3), fractional2(3)
+    double precision :: wrapped(3), fractional(3)
     integer :: i, indices(3)
-    type(subcell), pointer :: thesubcell
 
     ! get the wrapped fractional coordinates
     call wrapped_coordinates(at%position,cell,wrapped)
@@ -901,27 +1075,185 @@ contains
           indices(i) = min( cell%n_splits(i)+1, max( 0, int(floor( fractional(i)*cell%n_splits(i) ))+1 ) )
        end if
     end do
-    thesubcell => cell%subcells(indices(1),indices(2),indices(3))
-    thesubcell%n_atoms = thesubcell%n_atoms+1
-    thesubcell%atoms( thesubcell%n_atoms ) = at%index
     at%subcell_indices = indices
 
-    ! if the storage capacity is full, expand the subcell atom list size
-    if(thesubcell%n_atoms == thesubcell%max_atoms)then
+  end subroutine find_subcell_for_atom
+
+
+  ! Sorts the atoms in the subcells of a cell divided with :func:`divide_cell`.
+  !
+  ! The atoms are stored ordered by subcell, so that the atoms in the
+  ! subcell stored in slot i are 
+  ! ``cell%subcell_atoms(cell%subcell_first(i):cell%subcell_first(i+1)-1)``
+  ! in the order of increasing index.
+  !
+  ! If there are at most :data:`sparse_subcell_ratio` subcells per atom,
+  ! all subcells are stored and the slot of a subcell is its key (see :func:`subcell_key`).
+  ! For larger grids, for instance when there is a lot of vacuum in the cell, only the
+  ! occupied subcells are stored and they are found through a hash table. 
+  ! Either way, the memory required is proportional to the number of atoms.
+  !
+  ! *cell the supercell
+  ! *atoms the atoms, whose subcell indices are updated
+  subroutine assign_atoms_to_subcells(cell,atoms)
+    implicit none
+    type(supercell), intent(inout) :: cell
+    type(atom), intent(inout) :: atoms(:)
+    integer :: n_atoms, n_slots, i, slot, position, table_size
+    integer, allocatable :: atom_slots(:), counts(:)
+    integer(kind=8) :: key
+
+    n_atoms = size(atoms)
+    allocate(atom_slots(n_atoms))
+    
+    do i = 1, n_atoms
+       call find_subcell_for_atom(cell,atoms(i))
+    end do
+
+    cell%sparse_subcells = (cell%n_subcells > int(sparse_subcell_ratio,8)*max(n_atoms,1))
+
+    if(cell%sparse_subcells)then
+
+       ! Store the occupied subcells in a hash table with linear probing.
+       ! The table size is a prime at least twice the number of atoms
+       ! so that the keys of neighboring subcells do not collide systematically.
+       table_size = max(2*n_atoms+1, 11)
+       do while(.not.is_prime(table_size))
+          table_size = table_size + 1
+       end do
+       allocate(cell%subcell_hash(table_size))
+       allocate(cell%subcell_keys(n_atoms))
+       cell%subcell_hash = 0
+
+       n_slots = 0
+       do i = 1, n_atoms
+          key = subcell_key(cell,atoms(i)%subcell_indices)
+          position = int(modulo(key,int(table_size,8))) + 1
+          do
+             slot = cell%subcell_hash(position)
+             if(slot == 0)then
+                n_slots = n_slots + 1
+                slot = n_slots
+                cell%subcell_hash(position) = slot
+                cell%subcell_keys(slot) = key
+                exit
+             else if(cell%subcell_keys(slot) == key)then
+                exit
+             end if
+             position = mod(position,table_size) + 1
+          end do
+          atom_slots(i) = slot
+       end do
 
-       call expand_subcell_atom_capacity(thesubcell%atoms,&
-            thesubcell%n_atoms, &
-            thesubcell%max_atoms + 20)
+    else
 
-       thesubcell%max_atoms = thesubcell%max_atoms + 20
+       n_slots = int(cell%n_subcells)
+       do i = 1, n_atoms
+          atom_slots(i) = int(subcell_key(cell,atoms(i)%subcell_indices))
+       end do
+
+    end if
 
-       if(thesubcell%max_atoms > cell%max_subcell_atom_count)then
-          cell%max_subcell_atom_count = thesubcell%max_atoms
+    ! counting sort of the atoms by slot
+    allocate(counts(n_slots))
+    allocate(cell%subcell_first(n_slots+1))
+    allocate(cell%subcell_atoms(n_atoms))
+    counts = 0
+    do i = 1, n_atoms
+       counts(atom_slots(i)) = counts(atom_slots(i)) + 1
+    end do
+    cell%subcell_first(1) = 1
+    do slot = 1, n_slots
+       cell%subcell_first(slot+1) = cell%subcell_first(slot) + counts(slot)
+    end do
 
+    cell%n_occupied_subcells = count(counts > 0)
+    allocate(cell%occupied_subcells(cell%n_occupied_subcells))
+    position = 0
+    do slot = 1, n_slots
+       if(counts(slot) > 0)then
+          position = position + 1
+          cell%occupied_subcells(position) = slot
        end if
+    end do
+
+    counts = 0
+    do i = 1, n_atoms
+       slot = atom_slots(i)
+       cell%subcell_atoms(cell%subcell_first(slot)+counts(slot)) = i
+       counts(slot) = counts(slot) + 1
+    end do
+
+    deallocate(counts)
+    deallocate(atom_slots)
+
+  end subroutine assign_atoms_to_subcells
+
+
+  ! Returns the number of atoms in the subcell stored in the given slot.
+  !
+  ! *cell the supercell
+  ! *slot the slot of the subcell, 0 for an empty subcell
+  function atoms_in_subcell(cell,slot)
+    implicit none
+    integer :: atoms_in_subcell
+    type(supercell), intent(in) :: cell
+    integer, intent(in) :: slot
+
+    if(slot == 0)then
+       atoms_in_subcell = 0
+    else
+       atoms_in_subcell = cell%subcell_first(slot+1) - cell%subcell_first(slot)
     end if
 
-  end subroutine find_subcell_for_atom
+  end function atoms_in_subcell
+
+
+  ! Returns the indices of the subcell stored in the given slot.
+  !
+  ! *cell the supercell
+  ! *slot the slot of the subcell
+  ! *indices the indices of the subcell
+  subroutine get_subcell_indices(cell,slot,indices)
+    implicit none
+    type(supercell), intent(in) :: cell
+    integer, intent(in) :: slot
+    integer, intent(out) :: indices(3)
+    integer(kind=8) :: key, d1, d2
+
+    if(cell%sparse_subcells)then
+       key = cell%subcell_keys(slot) - 1
+    else
+       key = slot - 1
+    end if
+    d1 = cell%n_splits(1)+2
+    d2 = cell%n_splits(2)+2
+    indices(1) = int(modulo(key,d1))
+    indices(2) = int(modulo(key/d1,d2))
+    indices(3) = int(key/(d1*d2))
+
+  end subroutine get_subcell_indices
+
+
+  ! Returns true if the given number is a prime.
+  !
+  ! *number the number to be tested
+  function is_prime(number)
+    implicit none
+    logical :: is_prime
+    integer, intent(in) :: number
+    integer :: divisor
+
+    is_prime = (number > 1)
+    divisor = 2
+    do while(is_prime .and. divisor*divisor <= number)
+       if(mod(number,divisor) == 0)then
+          is_prime = .false.
+       end if
+       divisor = divisor + 1
+    end do
+
+  end function is_prime
 
 
 end module geometry
@@ -5,11 +5,12 @@
 ! This module handles the initialization of the MPI environment
 ! and assigns the cpus their indices. 
 ! Parallellization is done by 
-! distributing atoms on the processors and the routine for
-! doing this randomly is provided. Also tools for monitoring
+! distributing atoms on the processors. The atoms are distributed
+! by spatial domains: the simulation cell is divided in subcells
+! for neighbor searching and each cpu is given a contiguous block of
+! these subcells. Also tools for monitoring
 ! the loads of all the cpus and redistributing them are also implemented.
 module mpi
-  use mt95
   implicit none
 
 #ifdef MPI
@@ -31,10 +32,10 @@ module mpi
   ! *load_length the number of times loads have been recorded
   integer :: load_length
   ! *is_my_atom logical array, true for the indices of the atoms that are distributed to this cpu
-  ! *loads_mask logical array used in load rebalancing, true for cpus whose loads have not yet been balanced
-  logical, allocatable :: is_my_atom(:), loads_mask(:)
-  ! *atom_buffer list used for passing atom indices during load balancing
-  integer, allocatable :: atom_buffer(:)
+  ! *is_halo_atom logical array, true for the indices of the atoms that are not distributed to this cpu but are close enough to the atoms of this cpu that their neighbor lists are needed
+  logical, allocatable :: is_my_atom(:), is_halo_atom(:)
+  ! *domain_owners the cpu owning each spatial domain (subcell), in the order the domains are distributed
+  integer, allocatable :: domain_owners(:)
   ! *mpi_atoms_allocated logical switch for denoting that the mpi allocatable arrays have been allocated
   logical :: mpi_atoms_allocated = .false.
   ! *track_loads logical switch, if true, the loads of cpus are written to a file during run
@@ -43,7 +44,8 @@ module mpi
   ! *my_load storage for the load of this particular cpu
   double precision :: stopwatch, my_load
   ! *all_loads list of the loads of all cpus
-  double precision, allocatable :: all_loads(:)
+  ! *atom_costs the relative cost of evaluating the interactions of an atom on each cpu, as measured during load balancing
+  double precision, allocatable :: all_loads(:), atom_costs(:)
 
 
 contains
@@ -139,41 +141,116 @@ contains
 
 
 
-  ! distributes atoms among processors
+  ! Distributes atoms among processors.
+  !
+  ! The atoms are divided in contiguous blocks according to their indices.
+  ! This is only a starting point: when the neighbor lists are built,
+  ! the atoms are redistributed according to their positions
+  ! by :func:`mpi_distribute_domains`.
+  ! Until then, the neighbor lists of all atoms are needed, so all the atoms
+  ! not distributed to this cpu are marked as halo atoms.
+  !
   ! *n_atoms number of atoms
   subroutine mpi_distribute(n_atoms)
     implicit none
     integer, intent(in) :: n_atoms
-    integer :: i, random_int
-    double precision :: random_real
+    integer :: i
 
     if(.not.mpi_atoms_allocated)then
        allocate(is_my_atom(n_atoms))
+       allocate(is_halo_atom(n_atoms))
        mpi_atoms_allocated = .true.
     else
        deallocate(is_my_atom)
+       deallocate(is_halo_atom)
        allocate(is_my_atom(n_atoms))
+       allocate(is_halo_atom(n_atoms))
     end if
     my_atoms = 0
     all_atoms = n_atoms
     is_my_atom = .false.
     
     do i = 1, n_atoms
-
-       call genrand_real2(random_real)
-       random_int = floor(random_real*n_cpus)
-       if(random_int == cpu_id)then
+       if( ((i-1)*n_cpus)/n_atoms == cpu_id )then
           is_my_atom(i) = .true.
           my_atoms = my_atoms + 1
        end if
-
     end do
+    is_halo_atom = .not.is_my_atom
+
+    if(allocated(domain_owners))then
+       deallocate(domain_owners)
+    end if
 
     call initialize_load(.true.)
 
   end subroutine mpi_distribute
 
 
+  ! Distributes atoms among processors according to spatial domains.
+  !
+  ! The domains (subcells of the simulation cell) are given in an order
+  ! where consecutive domains are spatially adjacent.
+  ! Each cpu is given a contiguous block of domains so that the estimated
+  ! workloads of the cpus are as equal as possible. The workload of a domain
+  ! is estimated from the number of atoms in it and, if the loads have
+  ! been measured by :func:`balance_loads`, the cost of evaluating the
+  ! interactions of an atom on the cpu that owned the domain before.
+  !
+  ! The halo atoms are not determined here, since that requires knowledge
+  ! of the geometry of the domains. All halo tags are cleared and they should
+  ! be set by the caller.
+  !
+  ! *n_domains number of domains
+  ! *n_atoms number of atoms
+  ! *domain_atoms the number of atoms in each domain
+  ! *atom_domains the index of the domain of each atom
+  subroutine mpi_distribute_domains(n_domains,n_atoms,domain_atoms,atom_domains)
+    implicit none
+    integer, intent(in) :: n_domains, n_atoms, domain_atoms(n_domains), atom_domains(n_atoms)
+    double precision :: weights(n_domains), total_weight, cumulative
+    integer :: i
+
+    ! the measured costs only apply if the domains are the same as before
+    weights = domain_atoms
+    if(allocated(domain_owners))then
+       if(size(domain_owners) == n_domains)then
+          do i = 1, n_domains
+             weights(i) = domain_atoms(i) * atom_costs(domain_owners(i))
+          end do
+       end if
+       deallocate(domain_owners)
+    end if
+    allocate(domain_owners(n_domains))
+
+    ! assign each domain to the cpu whose share of the total weight
+    ! contains the midpoint of the domain
+    total_weight = sum(weights)
+    cumulative = 0.d0
+    do i = 1, n_domains
+       if(total_weight > 0.d0)then
+          domain_owners(i) = min( n_cpus-1, &
+               int( floor( n_cpus*(cumulative + 0.5d0*weights(i)) / total_weight ) ) )
+       else
+          domain_owners(i) = 0
+       end if
+       cumulative = cumulative + weights(i)
+    end do
+
+    my_atoms = 0
+    do i = 1, n_atoms
+       is_my_atom(i) = (domain_owners(atom_domains(i)) == cpu_id)
+       if(is_my_atom(i))then
+          my_atoms = my_atoms + 1
+       end if
+    end do
+    is_halo_atom = .false.
+
+    call initialize_load(.false.)
+
+  end subroutine mpi_distribute_domains
+
+
   ! Initializes the load monitoring arrays.
   !
   ! *reallocate Logical switch for reallocating the arrays. If true, the related arrays are allocated. Otherwise only the load counters are set to zero.
@@ -187,15 +264,12 @@ contains
        if(allocated(all_loads))then
           deallocate(all_loads)
        end if
-       if(allocated(loads_mask))then
-          deallocate(loads_mask)
-       end if
-       if(allocated(atom_buffer))then
-          deallocate(atom_buffer)
+       if(allocated(atom_costs))then
+          deallocate(atom_costs)
        end if
        allocate(all_loads(0:n_cpus-1))
-       allocate(loads_mask(0:n_cpus-1))
-       allocate(atom_buffer(all_atoms))
+       allocate(atom_costs(0:n_cpus-1))
+       atom_costs = 1.d0
     end if
 
   end subroutine initialize_load
@@ -216,91 +290,41 @@ contains
 
   ! Load balancing.
   !
-  ! The loads are gathered from all cpus and sorted. Then load (atoms)
-  ! is passed from the most loaded cpus to the least loaded ones.
+  ! The loads and the numbers of atoms are gathered from all cpus
+  ! and the cost of evaluating the interactions of a single atom is
+  ! estimated for each cpu. These costs are used for weighting the
+  ! domains the next time the atoms are distributed by 
+  ! :func:`mpi_distribute_domains`, which happens when the neighbor lists
+  ! are rebuilt. The atoms are not moved between cpus here, since
+  ! the neighbor lists of the new atoms would not be available.
   subroutine balance_loads()
     implicit none
-    integer :: i, j, k, min_cpu, max_cpu, swap_count, random_skip
-    double precision :: random
-
 #ifdef MPI
+    integer :: i, all_my_atoms(0:n_cpus-1)
+    double precision :: mean_cost
+
     if(load_length < 20)then
        return
     end if
 
-    ! gather the load estimates from all proc
+    ! gather the load estimates and atom counts from all proc
     call mpi_allgather(my_load,1,mpi_double_precision,all_loads,1,mpi_double_precision,mpi_comm_world,mpistat)
+    call mpi_allgather(my_atoms,1,mpi_integer,all_my_atoms,1,mpi_integer,mpi_comm_world,mpistat)
 
-    loads_mask=.true.
-
-    ! loop over pairs of most and least loaded cpus
-    do i = 1, n_cpus/2-mod(n_cpus,2)
-       
-       ! find the most and least loaded cpus of the ones still left
-       min_cpu = minloc(all_loads,1,loads_mask)-1
-       loads_mask(min_cpu) = .false.
-       max_cpu = maxloc(all_loads,1,loads_mask)-1
-       loads_mask(max_cpu) = .false.
-
-       ! if load imbalance between the two processes less than 2.5%, we do not swap 
-       if( (all_loads(max_cpu) - all_loads(min_cpu)) / &
-            (0.5*(all_loads(max_cpu)+all_loads(min_cpu))) < 0.025) then
-          exit
-       end if
-
-
-       ! a low load cpu takes up more tasks
-       if(cpu_id == min_cpu)then
+    ! if load imbalance is less than 2.5%, we keep the current costs
+    if( (maxval(all_loads) - minval(all_loads)) / &
+         (0.5*(maxval(all_loads)+minval(all_loads))) >= 0.025) then
 
-          ! get a list of atoms from a high load cpu specifying which atoms
-          ! are now allocated to this cpu
-          call mpi_recv(atom_buffer,all_atoms,mpi_integer,max_cpu,10,mpi_comm_world,mpistatus,mpistat)
-          call mpi_get_count(mpistatus,mpi_integer,swap_count,mpistat)
+       mean_cost = sum(all_loads) / max(1,sum(all_my_atoms))
+       do i = 0, n_cpus-1
+          if(all_my_atoms(i) > 0 .and. mean_cost > 0.d0)then
+             atom_costs(i) = all_loads(i) / all_my_atoms(i) / mean_cost
+          else
+             atom_costs(i) = 1.d0
+          end if
+       end do
 
-          do j = 1, swap_count
-
-             is_my_atom(atom_buffer(j)) = .true.
-             my_atoms = my_atoms + 1
-          end do
-       end if
-
-       ! a high load cpu gives away tasks
-       if(cpu_id == max_cpu)then
-          
-          ! estimate the number of atoms that should be allocated to another cpu
-          swap_count=max( 1, nint(0.5*my_atoms*( (all_loads(max_cpu)-all_loads(min_cpu)))/all_loads(max_cpu) ) )
-
-          ! pick atoms to swap
-          do j = 1, swap_count
-             
-             ! go through the list of atoms but skip some so that a random set of
-             ! atoms is sent instead of a bunch
-             call genrand_real1(random)
-             random_skip = floor(random*my_atoms)
-
-             do k = 1, all_atoms
-                if(is_my_atom(k))then
-
-                   ! we skipped enough atoms, so this one is chosen
-                   ! for sending off - it's added to the list of atoms
-                   if(random_skip == 0)then
-                      atom_buffer(j) = k
-                      is_my_atom(k) = .false.
-                      my_atoms = my_atoms - 1
-                      exit
-                   end if
-                   random_skip = random_skip - 1
-                end if
-             end do
-             
-          end do
-
-          ! send the list of atoms to a low load cpu
-          call mpi_send(atom_buffer,swap_count,mpi_integer,min_cpu,10,mpi_comm_world,mpistat)
-
-       end if
-
-    end do
+    end if
     
     ! set all loads to zero
     call initialize_load(.false.)
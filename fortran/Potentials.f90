@@ -282,15 +282,17 @@ module potentials
   ! *table array for storing tabulated values
   ! *n_product number of multipliers for a product potential
   ! *multipliers additional potentials with the same targets and cutoff, for potential multiplication
+  ! *derivative_parameter index of the parameter with respect to which the potential is differentiated in the parameter derivative mode, 0 if the potential is not differentiated
+  ! *shared_table logical switch specifying if the table points to a table in :data:`stored_tables` instead of a private copy
   type potential
-     integer :: type_index, pot_index, n_product
+     integer :: type_index, pot_index, n_product, derivative_parameter
      double precision, pointer :: parameters(:), derived_parameters(:), table(:,:)
      double precision :: cutoff, soft_cutoff
      character(len=2), pointer :: apply_elements(:) ! label_length
      integer, pointer :: apply_tags(:), apply_indices(:)
      character(len=2), pointer :: original_elements(:) ! label_length
      integer, pointer :: original_tags(:), original_indices(:)
-     logical :: filter_elements, filter_tags, filter_indices, smoothened
+     logical :: filter_elements, filter_tags, filter_indices, smoothened, shared_table
      type(potential), pointer :: multipliers(:)
   end type potential
 
@@ -314,6 +316,7 @@ module potentials
   ! *original_elements The list of elements (atomic symbols) of the original :class:`~pysic.BondOrderParameters` in the Python interface from which this factor was created. Whereas the apply_elements lists are used for finding all pairs and triplets of atoms which could contribute to the bond order factor, the original_elements lists specify the roles of atoms in the factor.
   ! *includes_post_processing a logical switch specifying if there is a scaling function :math:`s_i` attached to the factor
   ! *table array for storing tabulated values
+  ! *shared_table logical switch specifying if the table points to a table in :data:`stored_tables` instead of a private copy
   type bond_order_parameters
      integer :: type_index, group_index, n_level
      double precision, pointer :: parameters(:,:), derived_parameters(:,:), table(:,:)
@@ -321,17 +324,56 @@ module potentials
      integer, pointer :: n_params(:)
      character(len=2), pointer :: apply_elements(:) ! label_length
      character(len=2), pointer :: original_elements(:) ! label_length
-     logical :: includes_post_processing
+     logical :: includes_post_processing, shared_table
   end type bond_order_parameters
 
+  ! Defines a table of values stored in the core.
+  ! Tabulated potentials and bond order factors normally read their tables
+  ! from files, each getting a private copy. Instead, a table can be stored
+  ! in :data:`stored_tables` once and shared by all the potentials and factors 
+  ! given the negative index of the stored table as the id.
+  !
+  ! *values the tabulated values in the format of the table files, i.e., the values and the scaled derivatives in two columns
+  type stored_table
+     double precision, pointer :: values(:,:)
+  end type stored_table
+
+  ! *stored_tables tables shared by tabulated potentials and bond order factors
+  ! *n_stored_tables the size of the stored_tables array
+  type(stored_table), allocatable :: stored_tables(:)
+  integer :: n_stored_tables = 0
+
 
 
 
+  ! *parameter_derivative_mode Logical tag which switches the evaluation of parameter derivatives on. If true, :func:`evaluate_energy` and :func:`evaluate_forces` return the derivatives of the energy and forces with respect to the parameters marked by the derivative_parameter of each :data:`potential` instead of the energy and forces. Potentials without a marked parameter give zero.
+  logical :: parameter_derivative_mode = .false.
+
   ! temporary arrays for ewald summation
   double precision, pointer :: ewald_forces(:,:,:), ewald_sum_forces(:,:,:), ewald_tmp_enegs(:), &
-       s_factor(:,:,:,:), tmp_factor(:,:,:,:)
+       s_factor(:,:), tmp_factor(:,:)
   logical :: ewald_arrays_allocated = .false., s_factor_allocated = .false.
+
+  ! precomputed reciprocal lattice for ewald summation:
+  ! the indices (k1,k2,k3), the vectors k and the prefactors exp(-sigma^2 k^2 / 2) / k^2
+  ! of all the k-vectors within the k-space cutoff
+  integer :: n_ewald_k_vectors = 0
+  integer, pointer :: ewald_k_indices(:,:)
+  double precision, pointer :: ewald_k_vectors(:,:), ewald_k_prefactors(:)
+  ! phase factors exp(i k_j b_j.r) of a single atom along the reciprocal cell vectors b_j
+  double complex, pointer :: ewald_phases1(:), ewald_phases2(:), ewald_phases3(:)
   integer :: stored_factor_cutoffs(3)
+  double precision :: stored_k_reciprocal_cell(3,3), stored_k_radius, stored_k_gaussian_width
+
+  ! arrays for particle mesh ewald summation:
+  ! the charge grid (summed over cpus in MPI), the complex grid on which the
+  ! fourier transforms are done, and the influence function 
+  ! B(m) exp(-sigma^2 k^2 / 2) / k^2 of the reciprocal sum on the grid
+  double precision, pointer :: pme_charges(:,:,:), pme_tmp_charges(:,:,:), pme_influence(:,:,:)
+  double complex, pointer :: pme_mesh(:,:,:)
+  logical :: pme_arrays_allocated = .false.
+  integer :: stored_pme_grid(3), stored_pme_order
+  double precision :: stored_pme_reciprocal_cell(3,3), stored_pme_gaussian_width
 
 contains
 
@@ -352,50 +394,192 @@ contains
     if(s_factor_allocated)then
        deallocate(s_factor)
        deallocate(tmp_factor)
+       deallocate(ewald_k_indices)
+       deallocate(ewald_k_vectors)
+       deallocate(ewald_k_prefactors)
+       deallocate(ewald_phases1)
+       deallocate(ewald_phases2)
+       deallocate(ewald_phases3)
     else
        nullify(s_factor)
        nullify(tmp_factor)
+       nullify(ewald_k_indices)
+       nullify(ewald_k_vectors)
+       nullify(ewald_k_prefactors)
+       nullify(ewald_phases1)
+       nullify(ewald_phases2)
+       nullify(ewald_phases3)
     end if
     s_factor_allocated = .false.
+    n_ewald_k_vectors = 0
+
+    if(pme_arrays_allocated)then
+       deallocate(pme_charges)
+       deallocate(pme_tmp_charges)
+       deallocate(pme_influence)
+       deallocate(pme_mesh)
+    else
+       nullify(pme_charges)
+       nullify(pme_tmp_charges)
+       nullify(pme_influence)
+       nullify(pme_mesh)
+    end if
+    pme_arrays_allocated = .false.
 
   end subroutine deallocate_ewald_arrays
 
-  subroutine check_s_factor_array_allocation(n_atoms,reciprocal_cutoff)
+
+  ! Precomputes the reciprocal lattice for the Ewald summation.
+  !
+  ! The k-vectors :math:`\mathbf{k} = k_1 \mathbf{b}_1 + k_2 \mathbf{b}_2 + k_3 \mathbf{b}_3`
+  ! within the k-space cutoff are listed together with the 
+  ! prefactors :math:`e^{-\sigma^2 k^2 / 2} / k^2` of the reciprocal sum.
+  ! Only half of the lattice, :math:`k_3 \ge 0`, is stored and the
+  ! prefactors of the vectors with :math:`k_3 > 0` are doubled to account for the
+  ! vectors :math:`-\mathbf{k}`.
+  ! The list is only rebuilt if the cell or the summation parameters have
+  ! changed since the previous call, so repeated evaluations of the
+  ! energy, forces and electronegativities reuse the same list.
+  !
+  ! *cell the supercell containing the system
+  ! *k_radius absolute k-space cutoff
+  ! *reciprocal_cutoff The number of cells to be included in the reciprocal sum in the directions of the reciprocal cell vectors.
+  ! *gaussian_width The :math:`\sigma` parameter, i.e., the distribution width of the screening Gaussians.
+  subroutine update_ewald_k_vectors(cell,k_radius,reciprocal_cutoff,gaussian_width)
     implicit none
-    integer, intent(in) :: n_atoms, reciprocal_cutoff(3)
+    type(supercell), intent(in) :: cell
+    double precision, intent(in) :: k_radius, gaussian_width
+    integer, intent(in) :: reciprocal_cutoff(3)
+    double precision :: k_vector(3), k_sq, k_cut_sq
+    integer :: k1, k2, k3, n_k, pass
 
     if(s_factor_allocated)then
-       if(reciprocal_cutoff(1) /= stored_factor_cutoffs(1) .or. &
-            reciprocal_cutoff(2) /= stored_factor_cutoffs(2) .or. &
-            reciprocal_cutoff(3) /= stored_factor_cutoffs(3) )then          
-          deallocate(s_factor)
-          deallocate(tmp_factor)
-          allocate( s_factor(2, &
-               -reciprocal_cutoff(1):reciprocal_cutoff(1), &
-               -reciprocal_cutoff(2):reciprocal_cutoff(2), &
-               -reciprocal_cutoff(3):reciprocal_cutoff(3)) )
-          allocate( tmp_factor(2, &
-               -reciprocal_cutoff(1):reciprocal_cutoff(1), &
-               -reciprocal_cutoff(2):reciprocal_cutoff(2), &
-               -reciprocal_cutoff(3):reciprocal_cutoff(3)) )
-          stored_factor_cutoffs = reciprocal_cutoff
+       if( all(reciprocal_cutoff == stored_factor_cutoffs) .and. &
+            all(cell%reciprocal_cell == stored_k_reciprocal_cell) .and. &
+            k_radius == stored_k_radius .and. &
+            gaussian_width == stored_k_gaussian_width )then
+          return
        end if
-    else
-       nullify(s_factor)
-       nullify(tmp_factor)
-       allocate( s_factor(2, &
-            -reciprocal_cutoff(1):reciprocal_cutoff(1), &
-            -reciprocal_cutoff(2):reciprocal_cutoff(2), &
-            -reciprocal_cutoff(3):reciprocal_cutoff(3)) )
-       allocate( tmp_factor(2, &
-            -reciprocal_cutoff(1):reciprocal_cutoff(1), &
-            -reciprocal_cutoff(2):reciprocal_cutoff(2), &
-            -reciprocal_cutoff(3):reciprocal_cutoff(3)) )
-       stored_factor_cutoffs = reciprocal_cutoff
-       s_factor_allocated = .true.
+       deallocate(s_factor)
+       deallocate(tmp_factor)
+       deallocate(ewald_k_indices)
+       deallocate(ewald_k_vectors)
+       deallocate(ewald_k_prefactors)
+       deallocate(ewald_phases1)
+       deallocate(ewald_phases2)
+       deallocate(ewald_phases3)
+    end if
+
+    k_cut_sq = k_radius*k_radius
+
+    ! the first pass counts the k-vectors, the second one stores them
+    do pass = 1, 2
+       n_k = 0
+       do k1 = -reciprocal_cutoff(1), reciprocal_cutoff(1)
+          do k2 = -reciprocal_cutoff(2), reciprocal_cutoff(2)
+             do k3 = 0, reciprocal_cutoff(3)
+                if(k1 /= 0 .or. k2 /= 0 .or. k3 /= 0)then
+
+                   k_vector = k1*cell%reciprocal_cell(1:3,1) + &
+                        k2*cell%reciprocal_cell(1:3,2) + &
+                        k3*cell%reciprocal_cell(1:3,3)
+                   k_sq = k_vector .o. k_vector ! |k|^2
+
+                   if(k_sq < k_cut_sq)then
+                      n_k = n_k + 1
+                      if(pass == 2)then
+                         ewald_k_indices(1:3,n_k) = (/ k1, k2, k3 /)
+                         ewald_k_vectors(1:3,n_k) = k_vector
+                         ! exp(- sigma^2 k^2 / 2) / k^2, doubled for the -k vectors
+                         ewald_k_prefactors(n_k) = exp(-gaussian_width*gaussian_width*k_sq*0.5d0) / k_sq
+                         if(k3 /= 0)then
+                            ewald_k_prefactors(n_k) = 2.d0*ewald_k_prefactors(n_k)
+                         end if
+                      end if
+                   end if
+
+                end if
+             end do
+          end do
+       end do
+
+       if(pass == 1)then
+          allocate(ewald_k_indices(3,n_k))
+          allocate(ewald_k_vectors(3,n_k))
+          allocate(ewald_k_prefactors(n_k))
+          allocate(s_factor(2,n_k))
+          allocate(tmp_factor(2,n_k))
+       end if
+    end do
+
+    allocate(ewald_phases1(-reciprocal_cutoff(1):reciprocal_cutoff(1)))
+    allocate(ewald_phases2(-reciprocal_cutoff(2):reciprocal_cutoff(2)))
+    allocate(ewald_phases3(0:reciprocal_cutoff(3)))
+
+    n_ewald_k_vectors = n_k
+    stored_factor_cutoffs = reciprocal_cutoff
+    stored_k_reciprocal_cell = cell%reciprocal_cell
+    stored_k_radius = k_radius
+    stored_k_gaussian_width = gaussian_width
+    s_factor_allocated = .true.
+
+  end subroutine update_ewald_k_vectors
+
+
+  ! Calculates the phase factors :math:`e^{\mathrm{i} k_j \mathbf{b}_j \cdot \mathbf{r}}`
+  ! of an atom along the reciprocal cell vectors.
+  !
+  ! Only the first power of each phase is obtained from trigonometric functions.
+  ! The rest are generated by recurrence multiplication, and the phase
+  ! of a k-vector is then the product
+  ! :math:`e^{\mathrm{i} \mathbf{k} \cdot \mathbf{r}} = e^{\mathrm{i} k_1 \mathbf{b}_1 \cdot \mathbf{r}} e^{\mathrm{i} k_2 \mathbf{b}_2 \cdot \mathbf{r}} e^{\mathrm{i} k_3 \mathbf{b}_3 \cdot \mathbf{r}}`.
+  ! The results are stored in the arrays ``ewald_phases1``, ``ewald_phases2`` and ``ewald_phases3``.
+  !
+  ! *position coordinates of the atom
+  ! *cell the supercell containing the system
+  ! *reciprocal_cutoff The number of cells to be included in the reciprocal sum in the directions of the reciprocal cell vectors.
+  subroutine calculate_ewald_phase_factors(position,cell,reciprocal_cutoff)
+    implicit none
+    double precision, intent(in) :: position(3)
+    type(supercell), intent(in) :: cell
+    integer, intent(in) :: reciprocal_cutoff(3)
+    double precision :: dot
+    integer :: k
+
+    dot = cell%reciprocal_cell(1:3,1) .o. position
+    ewald_phases1(0) = (1.d0, 0.d0)
+    if(reciprocal_cutoff(1) > 0)then
+       ewald_phases1(1) = cmplx(cos(dot), sin(dot), kind(1.d0))
+       do k = 2, reciprocal_cutoff(1)
+          ewald_phases1(k) = ewald_phases1(k-1)*ewald_phases1(1)
+       end do
+       do k = 1, reciprocal_cutoff(1)
+          ewald_phases1(-k) = conjg(ewald_phases1(k))
+       end do
+    end if
+
+    dot = cell%reciprocal_cell(1:3,2) .o. position
+    ewald_phases2(0) = (1.d0, 0.d0)
+    if(reciprocal_cutoff(2) > 0)then
+       ewald_phases2(1) = cmplx(cos(dot), sin(dot), kind(1.d0))
+       do k = 2, reciprocal_cutoff(2)
+          ewald_phases2(k) = ewald_phases2(k-1)*ewald_phases2(1)
+       end do
+       do k = 1, reciprocal_cutoff(2)
+          ewald_phases2(-k) = conjg(ewald_phases2(k))
+       end do
+    end if
+
+    dot = cell%reciprocal_cell(1:3,3) .o. position
+    ewald_phases3(0) = (1.d0, 0.d0)
+    if(reciprocal_cutoff(3) > 0)then
+       ewald_phases3(1) = cmplx(cos(dot), sin(dot), kind(1.d0))
+       do k = 2, reciprocal_cutoff(3)
+          ewald_phases3(k) = ewald_phases3(k-1)*ewald_phases3(1)
+       end do
     end if
 
-  end subroutine check_s_factor_array_allocation
+  end subroutine calculate_ewald_phase_factors
 
 
   subroutine allocate_ewald_arrays(n_atoms)
@@ -966,6 +1150,60 @@ contains
 
   end subroutine get_number_of_targets_of_potential_index
 
+
+  ! !!!: check_discrete_parameter
+
+  ! Tells if a parameter of a potential is discrete, i.e., used as an integer
+  ! or an identifier instead of a continuous value. The energy does not
+  ! depend smoothly on such parameters, so they cannot be differentiated.
+  !
+  ! *pot_index index of the potential
+  ! *param index of the parameter
+  ! *discrete true if the parameter is discrete
+  subroutine check_discrete_parameter(pot_index,param,discrete)
+    implicit none
+    integer, intent(in) :: pot_index, param
+    logical, intent(out) :: discrete
+
+    !*********************************!
+    ! EDIT WHEN ADDING NEW POTENTIALS !
+    !*********************************!
+
+    select case (pot_index)
+    case (tri_bend_index) ! the exponents n and m
+       discrete = (param == 3 .or. param == 4)
+    case (mono_qself_index) ! the exponent n
+       discrete = (param == 2)
+    case (pair_qpair_index) ! the exponents n1 and n2
+       discrete = (param == 2 .or. param == 3)
+    case (pair_table_index) ! the table id
+       discrete = (param == 1)
+    case default
+       discrete = .false.
+    end select
+
+  end subroutine check_discrete_parameter
+
+
+  ! !!!: check_discrete_parameter_of_potential
+
+  ! Tells if a parameter of a potential is discrete, see :func:`check_discrete_parameter`.
+  !
+  ! *pot_name name of the potential
+  ! *param index of the parameter
+  ! *discrete true if the parameter is discrete
+  subroutine check_discrete_parameter_of_potential(pot_name,param,discrete)
+    implicit none
+    character(len=*), intent(in) :: pot_name
+    integer, intent(in) :: param
+    logical, intent(out) :: discrete
+    type(potential_descriptor) :: descriptor
+
+    call get_descriptor(pot_name,descriptor)
+    call check_discrete_parameter(descriptor%type_index,param,discrete)
+
+  end subroutine check_discrete_parameter_of_potential
+
   ! !!!: get_number_of_targets_of_bond_order_factor_index
 
   ! Returns the number of targets (i.e., bodies) of a bond order factor
@@ -1437,21 +1675,21 @@ contains
     logical, optional, intent(in) :: include_realspace
     double precision :: energy(7), tmp_energy(7), charge1, charge2, inv_eps_2v, inv_eps_4pi, &
          separation(3), distance, inv_sigma_sqrt_2pi, inv_sigma_sqrt_2, &
-         k_vector(3), dot, coords2(3), t1, t2, sine, cosine, exponential, k_cut_sq
-    integer :: index1, index2, j, k1, k2, k3, offset(3), n_atoms
+         t1, t2
+    double complex :: phase
+    integer :: index1, index2, j, k, n_atoms
     type(atom) :: atom1, atom2
     type(neighbor_list) :: nbors1
     logical :: evaluate
 
     n_atoms = size(atoms)
-    call check_s_factor_array_allocation(n_atoms,reciprocal_cutoff)
+    call update_ewald_k_vectors(cell,k_radius,reciprocal_cutoff,gaussian_width)
 
     energy = 0.d0
     tmp_energy = 0.d0
     total_energy = 0.d0
     s_factor = 0.d0
     tmp_factor = 0.d0
-    k_cut_sq = k_radius*k_radius
 
     inv_eps_4pi = 1.d0 / (4.d0 * pi * electric_constant)
     inv_eps_2v = 1.d0 / (2.d0 * cell%volume * electric_constant)
@@ -1523,28 +1761,15 @@ contains
              !
              ! calculate the structure factors
              !
-             do k1 = -reciprocal_cutoff(1), reciprocal_cutoff(1)
-                do k2 = -reciprocal_cutoff(2), reciprocal_cutoff(2)
-                   do k3 = 0, reciprocal_cutoff(3)
-                      if(k1 /= 0 .or. k2 /= 0 .or. k3 /= 0)then
-
-                         k_vector = k1*cell%reciprocal_cell(1:3,1) + &
-                              k2*cell%reciprocal_cell(1:3,2) + &
-                              k3*cell%reciprocal_cell(1:3,3)
-                         if( (k_vector.o.k_vector) < k_cut_sq)then
-                            dot = k_vector.o.atom1%position ! .o. in Quaternions.f90
-                            sine = charge1*sin(dot)
-                            cosine = charge1*cos(dot)
-                            
-                            ! S(k) = q exp(i k.r) = q [cos(k.r) + i sin(k.r)]
-                            tmp_factor(1:2,k1,k2,k3) = tmp_factor(1:2,k1,k2,k3) + &
-                                 (/ cosine, sine /)
-                            !tmp_factor(1:2,-k1,-k2,-k3) = tmp_factor(1:2,-k1,-k2,-k3) + &
-                            !     (/ cosine, -sine /)
-                         end if
-                      end if
-                   end do
-                end do
+             call calculate_ewald_phase_factors(atom1%position,cell,reciprocal_cutoff)
+             do k = 1, n_ewald_k_vectors
+                phase = ewald_phases1(ewald_k_indices(1,k)) * &
+                     ewald_phases2(ewald_k_indices(2,k)) * &
+                     ewald_phases3(ewald_k_indices(3,k))
+
+                ! S(k) = q exp(i k.r) = q [cos(k.r) + i sin(k.r)]
+                tmp_factor(1,k) = tmp_factor(1,k) + charge1*real(phase)
+                tmp_factor(2,k) = tmp_factor(2,k) + charge1*aimag(phase)
              end do
 
              !
@@ -1569,20 +1794,6 @@ contains
        end if
     end do
 
-!!$    do k1 = -reciprocal_cutoff(1), reciprocal_cutoff(1)
-!!$       do k2 = -reciprocal_cutoff(2), reciprocal_cutoff(2)
-!!$          do k3 = 0, reciprocal_cutoff(3)
-!!$             if(k1 /= 0 .or. k2 /= 0 .or. k3 /= 0)then
-!!$                
-!!$                ! S(k) = q exp(i k.r) = q [cos(k.r) + i sin(k.r)]
-!!$                tmp_factor(1,-k1,-k2,-k3) = tmp_factor(1,k1,k2,k3)
-!!$                tmp_factor(2,-k1,-k2,-k3) = -tmp_factor(2,k1,k2,k3)
-!!$                
-!!$             end if
-!!$          end do
-!!$       end do
-!!$    end do
-    
 #ifdef MPI
 	call timer(t1)
 	call record_load(t1)
@@ -1607,35 +1818,11 @@ contains
     !
     ! calculate the reciprocal space sum
     !
-    do k1 = -reciprocal_cutoff(1), reciprocal_cutoff(1)
-       do k2 = -reciprocal_cutoff(2), reciprocal_cutoff(2)
-          do k3 = 0, reciprocal_cutoff(3)
-             if(k1 /= 0 .or. k2 /= 0 .or. k3 /= 0)then
-
-                k_vector = k1*cell%reciprocal_cell(1:3,1) + &
-                     k2*cell%reciprocal_cell(1:3,2) + &
-                     k3*cell%reciprocal_cell(1:3,3)
-                distance = (k_vector .o. k_vector) ! |k|^2
-
-                if( (distance) < k_cut_sq)then
-                   exponential = exp(-gaussian_width*gaussian_width*distance*0.5d0) / (distance)
-                   
-                   if(k3 == 0)then
-                      ! exp(- sigma^2 k^2 / 2) / k^2 |S(k)|^2
-                      ! |z|^2 = x^2 + y^2
-                      tmp_energy(3) = tmp_energy(3) + exponential * &
-                           (s_factor(1,k1,k2,k3)*s_factor(1,k1,k2,k3) + s_factor(2,k1,k2,k3)*s_factor(2,k1,k2,k3))
-                   else
-                      ! exp(- sigma^2 k^2 / 2) / k^2 |S(k)|^2
-                      ! |z|^2 = x^2 + y^2
-                      tmp_energy(3) = tmp_energy(3) + 2.d0*exponential * &
-                           (s_factor(1,k1,k2,k3)*s_factor(1,k1,k2,k3) + s_factor(2,k1,k2,k3)*s_factor(2,k1,k2,k3))
-                   end if
-                end if
-
-             end if
-          end do
-       end do
+    do k = 1, n_ewald_k_vectors
+       ! exp(- sigma^2 k^2 / 2) / k^2 |S(k)|^2
+       ! |z|^2 = x^2 + y^2
+       tmp_energy(3) = tmp_energy(3) + ewald_k_prefactors(k) * &
+            (s_factor(1,k)*s_factor(1,k) + s_factor(2,k)*s_factor(2,k))
     end do
 
 
@@ -1653,6 +1840,107 @@ contains
   end subroutine calculate_ewald_energy
 
 
+  ! Calculates the change in the reciprocal space, self and charged background
+  ! energies of Ewald summation (see :func:`calculate_ewald_energy`)
+  ! when some atoms are moved or their charges are changed.
+  !
+  ! Since the structure factor is a sum over the charges,
+  !
+  ! .. math::
+  !
+  !    S(\mathbf{k}) = \sum_i q_i e^{\mathrm{i} \mathbf{k} \cdot \mathbf{r}_i},
+  !
+  ! the change due to the modified atoms, :math:`\Delta S(\mathbf{k})`, is obtained 
+  ! from the old and new charges and positions of those atoms only.
+  ! The change in the reciprocal energy is then 
+  ! :math:`\propto \sum_{\mathbf{k}} |S(\mathbf{k}) + \Delta S(\mathbf{k})|^2 - |S(\mathbf{k})|^2`,
+  ! so the cost is proportional to the number of k-vectors but does not
+  ! depend on the number of atoms.
+  !
+  ! The structure factors of the whole system must have been calculated
+  ! with :func:`calculate_ewald_energy` for the same cell and summation parameters.
+  ! They are not updated here, but the change is returned so that it can be added
+  ! to ``s_factor`` if the modification is kept.
+  ! The real space part is not included.
+  !
+  ! *old_positions the positions of the modified atoms before the modification
+  ! *new_positions the positions of the modified atoms after the modification
+  ! *old_charges the scaled charges of the modified atoms before the modification
+  ! *new_charges the scaled charges of the modified atoms after the modification
+  ! *cell the supercell containing the system
+  ! *reciprocal_cutoff The number of cells to be included in the reciprocal sum in the directions of the reciprocal cell vectors.
+  ! *gaussian_width The :math:`\sigma` parameter, i.e., the distribution width of the screening Gaussians.
+  ! *electric_constant The electic constant, i.e., vacuum permittivity :math:`\varepsilon_0`.
+  ! *total_charge the sum of the scaled charges of all atoms before the modification
+  ! *energy_change the calculated change in energy
+  ! *factor_change the calculated change in the structure factors
+  subroutine calculate_ewald_energy_change(old_positions,new_positions,old_charges,new_charges,&
+       cell,reciprocal_cutoff,gaussian_width,electric_constant,total_charge,energy_change,factor_change)
+    implicit none
+    double precision, intent(in) :: old_positions(:,:), new_positions(:,:), old_charges(:), new_charges(:), &
+         gaussian_width, electric_constant, total_charge
+    type(supercell), intent(in) :: cell
+    integer, intent(in) :: reciprocal_cutoff(3)
+    double precision, intent(out) :: energy_change, factor_change(:,:)
+    double precision :: inv_eps_2v, inv_eps_4pi, inv_sigma_sqrt_2pi, charge_change, &
+         reciprocal_change, self_change
+    double complex :: phase
+    integer :: i, k
+
+    inv_eps_4pi = 1.d0 / (4.d0 * pi * electric_constant)
+    inv_eps_2v = 1.d0 / (2.d0 * cell%volume * electric_constant)
+    inv_sigma_sqrt_2pi = 1.d0 / (sqrt(2.d0 * pi) * gaussian_width)
+
+    factor_change(1:2,1:n_ewald_k_vectors) = 0.d0
+    charge_change = 0.d0
+    self_change = 0.d0
+
+    do i = 1, size(old_charges)
+
+       ! remove the old contribution of the atom
+       if(old_charges(i) /= 0.d0)then
+          call calculate_ewald_phase_factors(old_positions(1:3,i),cell,reciprocal_cutoff)
+          do k = 1, n_ewald_k_vectors
+             phase = ewald_phases1(ewald_k_indices(1,k)) * &
+                  ewald_phases2(ewald_k_indices(2,k)) * &
+                  ewald_phases3(ewald_k_indices(3,k))
+             factor_change(1,k) = factor_change(1,k) - old_charges(i)*real(phase)
+             factor_change(2,k) = factor_change(2,k) - old_charges(i)*aimag(phase)
+          end do
+       end if
+
+       ! add the new one
+       if(new_charges(i) /= 0.d0)then
+          call calculate_ewald_phase_factors(new_positions(1:3,i),cell,reciprocal_cutoff)
+          do k = 1, n_ewald_k_vectors
+             phase = ewald_phases1(ewald_k_indices(1,k)) * &
+                  ewald_phases2(ewald_k_indices(2,k)) * &
+                  ewald_phases3(ewald_k_indices(3,k))
+             factor_change(1,k) = factor_change(1,k) + new_charges(i)*real(phase)
+             factor_change(2,k) = factor_change(2,k) + new_charges(i)*aimag(phase)
+          end do
+       end if
+
+       self_change = self_change + new_charges(i)*new_charges(i) - old_charges(i)*old_charges(i)
+       charge_change = charge_change + new_charges(i) - old_charges(i)
+
+    end do
+
+    ! |S + dS|^2 - |S|^2 = 2 S.dS + |dS|^2
+    reciprocal_change = 0.d0
+    do k = 1, n_ewald_k_vectors
+       reciprocal_change = reciprocal_change + ewald_k_prefactors(k) * &
+            ( factor_change(1,k)*(2.d0*s_factor(1,k) + factor_change(1,k)) + &
+            factor_change(2,k)*(2.d0*s_factor(2,k) + factor_change(2,k)) )
+    end do
+
+    energy_change = reciprocal_change * inv_eps_2v &
+         - self_change * inv_eps_4pi * inv_sigma_sqrt_2pi &
+         - charge_change*(2.d0*total_charge + charge_change) * 0.5d0 * inv_eps_2v * gaussian_width*gaussian_width
+
+  end subroutine calculate_ewald_energy_change
+
+
   ! Calculates the forces due to long ranged :math:`\frac{1}{r}` potentials.
   ! These forces are the gradients of the energies :math:`U` given by :func:`calculate_ewald_energy`
   !
@@ -1683,27 +1971,27 @@ contains
     logical, intent(in) :: include_dipole_correction
     logical, optional, intent(in) :: include_realspace
     double precision, save :: tmp_forces(3), charge1, charge2, &
-         inv_eps_2v, inv_eps_4pi, sin_dot, cos_dot, &
+         inv_eps_2v, inv_eps_4pi, &
          separation(3), distance, inv_dist, inv_sigma_sqrt_2pi, &
          inv_sigma_sqrt_2, inv_sigma_sqrt_2perpi, inv_sigma_sq_2, &
-         nabla_factor(3,2), stress(6), &
-         k_vector(3), dot, &
-         dipole(1:3), tmp_dipole(1:3), t1, t2, k_cut_sq
-    integer :: index1, index2, j, k1, k2, k3, count, n_atoms
+         stress(6), &
+         dipole(1:3), tmp_dipole(1:3), t1, t2
+    double complex :: phase
+    integer :: index1, index2, j, k, n_atoms
     type(atom) :: atom1, atom2
     type(neighbor_list) :: nbors1
     logical :: evaluate
 
     n_atoms = size(atoms)
-    call check_s_factor_array_allocation(n_atoms,reciprocal_cutoff)
+    call update_ewald_k_vectors(cell,k_radius,reciprocal_cutoff,gaussian_width)
 
     ewald_forces = 0.d0
     tmp_forces = 0.d0
     total_forces = 0.d0
     s_factor = 0.d0
     tmp_factor = 0.d0
-    nabla_factor = 0.d0
-    k_cut_sq = k_radius*k_radius
+    dipole = 0.d0
+    tmp_dipole = 0.d0
 
     stress = 0.d0
     total_stress = 0.d0
@@ -1809,28 +2097,16 @@ contains
              !
              ! calculate the structure factors
              !             
-             do k1 = -reciprocal_cutoff(1), reciprocal_cutoff(1)
-                do k2 = -reciprocal_cutoff(2), reciprocal_cutoff(2)
-                   do k3 = 0, reciprocal_cutoff(3)
-                      if(k1 /= 0 .or. k2 /= 0 .or. k3 /= 0)then
-
-                         k_vector = k1*cell%reciprocal_cell(1:3,1) + &
-                              k2*cell%reciprocal_cell(1:3,2) + &
-                              k3*cell%reciprocal_cell(1:3,3)
-
-                         if((k_vector .o. k_vector) < k_cut_sq)then
-                            dot = k_vector.o.atom1%position ! .o. in Quaternions.f90
-                            sin_dot = sin(dot)
-                            cos_dot = cos(dot)
-
-                            ! this is the complex conjugate of S(k):
-                            ! S*(k) = q exp(- i k.r) = q [cos(k.r) - i sin(k.r)]
-                            tmp_factor(1:2,k1,k2,k3) = tmp_factor(1:2,k1,k2,k3) + &
-                                 (/ charge1 * cos_dot, - charge1 * sin_dot /)
-                         end if
-                      end if
-                   end do
-                end do
+             call calculate_ewald_phase_factors(atom1%position,cell,reciprocal_cutoff)
+             do k = 1, n_ewald_k_vectors
+                phase = ewald_phases1(ewald_k_indices(1,k)) * &
+                     ewald_phases2(ewald_k_indices(2,k)) * &
+                     ewald_phases3(ewald_k_indices(3,k))
+
+                ! this is the complex conjugate of S(k):
+                ! S*(k) = q exp(- i k.r) = q [cos(k.r) - i sin(k.r)]
+                tmp_factor(1,k) = tmp_factor(1,k) + charge1*real(phase)
+                tmp_factor(2,k) = tmp_factor(2,k) - charge1*aimag(phase)
              end do
 
           end if
@@ -1841,18 +2117,6 @@ contains
     end do
 
 
-!!$    do k1 = -reciprocal_cutoff(1), reciprocal_cutoff(1)
-!!$       do k2 = -reciprocal_cutoff(2), reciprocal_cutoff(2)
-!!$          do k3 = 0, reciprocal_cutoff(3)
-!!$                
-!!$                ! S*(k) = q exp(i k.r) = q [cos(k.r) - i sin(k.r)]
-!!$                tmp_factor(1,-k1,-k2,-k3) = tmp_factor(1,k1,k2,k3)
-!!$                tmp_factor(2,-k1,-k2,-k3) = -tmp_factor(2,k1,k2,k3)
-!!$                
-!!$          end do
-!!$       end do
-!!$    end do
-
 #ifdef MPI
 
     call timer(t1)
@@ -1861,7 +2125,7 @@ contains
     call mpi_allreduce(tmp_factor,s_factor,size(s_factor),mpi_double_precision,&
          mpi_sum,mpi_comm_world,mpistat)
     if(include_dipole_correction)then
-       call mpi_allreduce(tmp_dipole,dipole,1,mpi_double_precision,&
+       call mpi_allreduce(tmp_dipole,dipole,size(dipole),mpi_double_precision,&
             mpi_sum,mpi_comm_world,mpistat)
     end if
 
@@ -1889,52 +2153,22 @@ contains
           !
           ! calculate the reciprocal space sum
           !
-          do k1 = -reciprocal_cutoff(1), reciprocal_cutoff(1)
-             do k2 = -reciprocal_cutoff(2), reciprocal_cutoff(2)
-                do k3 = 0, reciprocal_cutoff(3)
-                   if(k1 /= 0 .or. k2 /= 0 .or. k3 /= 0)then
-                      
-                      k_vector = k1*cell%reciprocal_cell(1:3,1) + &
-                           k2*cell%reciprocal_cell(1:3,2) + &
-                           k3*cell%reciprocal_cell(1:3,3)
-                      distance = k_vector .o. k_vector ! |k|^2
-                      if(distance < k_cut_sq)then
-                         dot = k_vector.o.atom1%position ! .o. in Quaternions.f90
-                         sin_dot = sin(dot)
-                         cos_dot = cos(dot)
-                      
-                         ! \nabla S(k) = i q k [cos(k.r) + i sin(k.r)]
-                         k_vector = charge1 * k_vector
-                         nabla_factor(1:3,1) = &
-                              -sin_dot * k_vector ! real part
-                         nabla_factor(1:3,2) = &
-                              cos_dot * k_vector ! imaginary part   
-
-                         if(k3 == 0)then
-                            ! - exp(- sigma^2 k^2 / 2) / k^2 2 Re[ S*(k) \nabla S(k) ]
-                            ! Re[ z1 z2 ] = x1 x2 - y1 y2  (z = x + iy)
-                            ewald_forces(1:3,2,index1) = ewald_forces(1:3,2,index1) - inv_eps_2v * &
-                                 exp(-gaussian_width*gaussian_width*distance*0.5d0) / &
-                                 (distance) * 2.d0 * &
-                                 (s_factor(1,k1,k2,k3)*nabla_factor(1:3,1) - &
-                                 s_factor(2,k1,k2,k3)*nabla_factor(1:3,2))
-                         else
-                            ! - exp(- sigma^2 k^2 / 2) / k^2 2 Re[ S*(k) \nabla S(k) ]
-                            ! Re[ z1 z2 ] = x1 x2 - y1 y2  (z = x + iy)
-                            ewald_forces(1:3,2,index1) = ewald_forces(1:3,2,index1) - inv_eps_2v * &
-                                 exp(-gaussian_width*gaussian_width*distance*0.5d0) / &
-                                 (distance) * 4.d0 * &
-                                 (s_factor(1,k1,k2,k3)*nabla_factor(1:3,1) - &
-                                 s_factor(2,k1,k2,k3)*nabla_factor(1:3,2))
-
-                         end if
-
-                      end if
-
-                   end if
-                end do
+          if(charge1 /= 0.d0)then
+             call calculate_ewald_phase_factors(atom1%position,cell,reciprocal_cutoff)
+             do k = 1, n_ewald_k_vectors
+                phase = ewald_phases1(ewald_k_indices(1,k)) * &
+                     ewald_phases2(ewald_k_indices(2,k)) * &
+                     ewald_phases3(ewald_k_indices(3,k))
+
+                ! \nabla S(k) = i q k [cos(k.r) + i sin(k.r)]
+                ! - exp(- sigma^2 k^2 / 2) / k^2 2 Re[ S*(k) \nabla S(k) ]
+                ! Re[ z1 z2 ] = x1 x2 - y1 y2  (z = x + iy)
+                ewald_forces(1:3,2,index1) = ewald_forces(1:3,2,index1) - inv_eps_2v * &
+                     2.d0 * ewald_k_prefactors(k) * charge1 * &
+                     ( -s_factor(1,k)*aimag(phase) - s_factor(2,k)*real(phase) ) * &
+                     ewald_k_vectors(1:3,k)
              end do
-          end do
+          end if
 
           ! stress tensor
           stress(1) = stress(1) + atoms(index1)%position(1) * (ewald_forces(1,2,index1) + ewald_forces(1,3,index1))
@@ -2002,21 +2236,22 @@ contains
     double precision :: tmp, qsum(4), tmp_qsum(4), &
          charge1, charge2, inv_eps_2v, inv_eps_4pi, &
          separation(3), distance, inv_sigma_sqrt_2pi, inv_sigma_sqrt_2, &
-         k_vector(3), dot, sin_dot, cos_dot, coords2(3), t1, t2, k_cut_sq
-    integer :: index1, index2, j, k1, k2, k3, offset(3), n_atoms
+         t1, t2
+    double complex :: phase
+    integer :: index1, index2, j, k, n_atoms
     type(atom) :: atom1, atom2
     type(neighbor_list) :: nbors1
     logical :: evaluate
 
     n_atoms = size(atoms)
-    call check_s_factor_array_allocation(n_atoms,reciprocal_cutoff)
+    call update_ewald_k_vectors(cell,k_radius,reciprocal_cutoff,gaussian_width)
 
     ewald_tmp_enegs = 0.d0
     total_enegs = 0.d0
     s_factor = 0.d0
     tmp_factor = 0.d0
     qsum = 0.d0
-    k_cut_sq = k_radius*k_radius
+    tmp_qsum = 0.d0
 
     inv_eps_4pi = 1.d0 / (4.d0 * pi * electric_constant)
     inv_eps_2v = 1.d0 / (2.d0 * cell%volume * electric_constant)
@@ -2088,29 +2323,19 @@ contains
           !
           ! calculate the structure factors
           !
-          do k1 = -reciprocal_cutoff(1), reciprocal_cutoff(1)
-             do k2 = -reciprocal_cutoff(2), reciprocal_cutoff(2)
-                do k3 = 0, reciprocal_cutoff(3)
-                   if(k1 /= 0 .or. k2 /= 0 .or. k3 /= 0)then
-                      
-                      k_vector = k1*cell%reciprocal_cell(1:3,1) + &
-                           k2*cell%reciprocal_cell(1:3,2) + &
-                           k3*cell%reciprocal_cell(1:3,3)
-                      if( (k_vector.o.k_vector) < k_cut_sq)then
-                         dot = k_vector.o.atom1%position ! .o. in Quaternions.f90
-                         sin_dot = sin(dot)
-                         cos_dot = cos(dot)
-                         
-                         ! this is the complex conjugate of S(k):
-                         ! S*(k) = q exp(- i k.r) = q [cos(k.r) - i sin(k.r)]
-                         tmp_factor(1:2,k1,k2,k3) = tmp_factor(1:2,k1,k2,k3) + &
-                              (/ charge1 * cos_dot, - charge1 * sin_dot /)
-                      end if
-                      
-                   end if
-                end do
+          if(charge1 /= 0.d0)then
+             call calculate_ewald_phase_factors(atom1%position,cell,reciprocal_cutoff)
+             do k = 1, n_ewald_k_vectors
+                phase = ewald_phases1(ewald_k_indices(1,k)) * &
+                     ewald_phases2(ewald_k_indices(2,k)) * &
+                     ewald_phases3(ewald_k_indices(3,k))
+                
+                ! this is the complex conjugate of S(k):
+                ! S*(k) = q exp(- i k.r) = q [cos(k.r) - i sin(k.r)]
+                tmp_factor(1,k) = tmp_factor(1,k) + charge1*real(phase)
+                tmp_factor(2,k) = tmp_factor(2,k) - charge1*aimag(phase)
              end do
-          end do
+          end if
 
           !
           ! calculate the self energy term
@@ -2133,18 +2358,6 @@ contains
 
     end do
 
-!!$    do k1 = -reciprocal_cutoff(1), reciprocal_cutoff(1)
-!!$       do k2 = -reciprocal_cutoff(2), reciprocal_cutoff(2)
-!!$          do k3 = 0, reciprocal_cutoff(3)
-!!$                
-!!$                ! S*(k) = q exp(i k.r) = q [cos(k.r) - i sin(k.r)]
-!!$                tmp_factor(1,-k1,-k2,-k3) = tmp_factor(1,k1,k2,k3)
-!!$                tmp_factor(2,-k1,-k2,-k3) = -tmp_factor(2,k1,k2,k3)
-!!$                
-!!$          end do
-!!$       end do
-!!$    end do
-
 #ifdef MPI
 
 	call timer(t1)
@@ -2187,58 +2400,833 @@ contains
           !
           ! calculate the reciprocal space sum
           !
-          do k1 = -reciprocal_cutoff(1), reciprocal_cutoff(1)
-             do k2 = -reciprocal_cutoff(2), reciprocal_cutoff(2)
-                do k3 = 0, reciprocal_cutoff(3)
-                   if(k1 /= 0 .or. k2 /= 0 .or. k3 /= 0)then
-                      
-                      k_vector = k1*cell%reciprocal_cell(1:3,1) + &
-                           k2*cell%reciprocal_cell(1:3,2) + &
-                           k3*cell%reciprocal_cell(1:3,3)
-                      distance = (k_vector .o. k_vector) ! |k|^2
-
-                      if( (distance) < k_cut_sq)then
-                         dot = k_vector.o.atom1%position ! .o. in Quaternions.f90
-                         sin_dot = sin(dot)
-                         cos_dot = cos(dot)
-                      
-                         if(k3 == 0)then
-
-                            ! - exp(- sigma^2 k^2 / 2) / k^2 2 Re[ S*(k) d S(k) ]
-                            ! Re[ z1 z2 ] = x1 x2 - y1 y2
-                            ! d S(k) = exp(i k.r) = [cos(k.r) + i sin(k.r)]
-                            ewald_tmp_enegs(index1) = ewald_tmp_enegs(index1) - inv_eps_2v * &
-                                 exp(-gaussian_width*gaussian_width*distance*0.5d0) / &
-                                 (distance) * 2.d0 * &
-                                 (s_factor(1,k1,k2,k3) * cos_dot - &
-                                 s_factor(2,k1,k2,k3) * sin_dot)
-                         else
-
-                            ! - exp(- sigma^2 k^2 / 2) / k^2 2 Re[ S*(k) d S(k) ]
-                            ! Re[ z1 z2 ] = x1 x2 - y1 y2
-                            ! d S(k) = exp(i k.r) = [cos(k.r) + i sin(k.r)]
-                            ewald_tmp_enegs(index1) = ewald_tmp_enegs(index1) - inv_eps_2v * &
-                                 exp(-gaussian_width*gaussian_width*distance*0.5d0) / &
-                                 (distance) * 4.d0 * &
-                                 (s_factor(1,k1,k2,k3) * cos_dot - &
-                                 s_factor(2,k1,k2,k3) * sin_dot)
+          call calculate_ewald_phase_factors(atom1%position,cell,reciprocal_cutoff)
+          do k = 1, n_ewald_k_vectors
+             phase = ewald_phases1(ewald_k_indices(1,k)) * &
+                  ewald_phases2(ewald_k_indices(2,k)) * &
+                  ewald_phases3(ewald_k_indices(3,k))
+
+             ! - exp(- sigma^2 k^2 / 2) / k^2 2 Re[ S*(k) d S(k) ]
+             ! Re[ z1 z2 ] = x1 x2 - y1 y2
+             ! d S(k) = exp(i k.r) = [cos(k.r) + i sin(k.r)]
+             ewald_tmp_enegs(index1) = ewald_tmp_enegs(index1) - inv_eps_2v * &
+                  2.d0 * ewald_k_prefactors(k) * &
+                  (s_factor(1,k) * real(phase) - &
+                  s_factor(2,k) * aimag(phase))
+          end do
+       end if
+    end do
 
-                         end if
+#ifdef MPI
 
-                      end if
+	call timer(t2)
+	call record_load(t1+t2)
 
-                   end if
+    ! collect electronegativities from all cpus in MPI
+    call mpi_allreduce(ewald_tmp_enegs,total_enegs,size(ewald_tmp_enegs),mpi_double_precision,&
+         mpi_sum,mpi_comm_world,mpistat)
+#else
+    total_enegs = ewald_tmp_enegs
+#endif
+
+  end subroutine calculate_ewald_electronegativities
+
+  ! Prepares the grids for particle mesh Ewald summation.
+  !
+  ! The grids are allocated and the influence function
+  !
+  ! .. math::
+  !
+  !    G(\mathbf{m}) = \frac{e^{-\sigma^2 k^2 / 2}}{k^2} \prod_{j=1}^3 |b_j(m_j)|^2
+  !
+  ! is tabulated on the grid. Here :math:`\mathbf{k} = m_1 \mathbf{b}_1 + m_2 \mathbf{b}_2 + m_3 \mathbf{b}_3` is the
+  ! reciprocal lattice vector corresponding to the grid point :math:`\mathbf{m}` and :math:`b_j(m_j)` are the
+  ! Euler exponential spline factors of the smooth particle mesh Ewald method, see :func:`calculate_pme_energy`.
+  ! The grid and the function are only recalculated if the cell or
+  ! the summation parameters have changed since the previous call.
+  !
+  ! *cell the supercell containing the system
+  ! *grid the number of grid points along each cell vector
+  ! *order the order of the B-splines used for interpolating the charges on the grid
+  ! *gaussian_width The :math:`\sigma` parameter, i.e., the distribution width of the screening Gaussians.
+  subroutine update_pme_grid(cell,grid,order,gaussian_width)
+    implicit none
+    type(supercell), intent(in) :: cell
+    integer, intent(in) :: grid(3), order
+    double precision, intent(in) :: gaussian_width
+    double precision :: k_vector(3), k_sq, weights(0:order-1), derivatives(0:order-1), &
+         spline_moduli(0:maxval(grid)-1,3), arg
+    double complex :: factor
+    integer :: m1, m2, m3, shifted(3), dim, m, j
+
+    if(pme_arrays_allocated)then
+       if( all(grid == stored_pme_grid) .and. order == stored_pme_order .and. &
+            all(cell%reciprocal_cell == stored_pme_reciprocal_cell) .and. &
+            gaussian_width == stored_pme_gaussian_width )then
+          return
+       end if
+       if( any(grid /= stored_pme_grid) )then
+          deallocate(pme_charges)
+          deallocate(pme_tmp_charges)
+          deallocate(pme_influence)
+          deallocate(pme_mesh)
+          pme_arrays_allocated = .false.
+       end if
+    end if
+
+    if(.not.pme_arrays_allocated)then
+       allocate(pme_charges(0:grid(1)-1,0:grid(2)-1,0:grid(3)-1))
+       allocate(pme_tmp_charges(0:grid(1)-1,0:grid(2)-1,0:grid(3)-1))
+       allocate(pme_influence(0:grid(1)-1,0:grid(2)-1,0:grid(3)-1))
+       allocate(pme_mesh(0:grid(1)-1,0:grid(2)-1,0:grid(3)-1))
+       pme_arrays_allocated = .true.
+    end if
+
+    ! the spline moduli |sum_j M_n(j) exp(2 pi i m j / K)|^2 = 1 / |b(m)|^2
+    call pme_bspline_weights(0.d0,order,weights,derivatives)
+    do dim = 1, 3
+       do m = 0, grid(dim)-1
+          factor = (0.d0, 0.d0)
+          do j = 1, order-1
+             arg = 2.d0*pi*m*j / grid(dim)
+             factor = factor + weights(j) * cmplx(cos(arg), sin(arg), kind(1.d0))
+          end do
+          spline_moduli(m,dim) = real(factor)*real(factor) + aimag(factor)*aimag(factor)
+       end do
+       ! for odd orders the modulus vanishes at the Nyquist frequency,
+       ! so it is interpolated from the neighboring values
+       do m = 0, grid(dim)-1
+          if(spline_moduli(m,dim) < 1.d-7)then
+             spline_moduli(m,dim) = 0.5d0 * ( spline_moduli(modulo(m-1,grid(dim)),dim) + &
+                  spline_moduli(modulo(m+1,grid(dim)),dim) )
+          end if
+       end do
+    end do
+
+    do m3 = 0, grid(3)-1
+       do m2 = 0, grid(2)-1
+          do m1 = 0, grid(1)-1
+             ! map the grid indices to frequencies -K/2 < m <= K/2
+             shifted = (/ m1, m2, m3 /)
+             where(2*shifted > grid) shifted = shifted - grid
+
+             k_vector = shifted(1)*cell%reciprocal_cell(1:3,1) + &
+                  shifted(2)*cell%reciprocal_cell(1:3,2) + &
+                  shifted(3)*cell%reciprocal_cell(1:3,3)
+             k_sq = k_vector .o. k_vector ! |k|^2
+
+             if(m1 == 0 .and. m2 == 0 .and. m3 == 0)then
+                pme_influence(m1,m2,m3) = 0.d0
+             else
+                pme_influence(m1,m2,m3) = exp(-gaussian_width*gaussian_width*k_sq*0.5d0) / k_sq / &
+                     ( spline_moduli(m1,1) * spline_moduli(m2,2) * spline_moduli(m3,3) )
+             end if
+          end do
+       end do
+    end do
+
+    stored_pme_grid = grid
+    stored_pme_order = order
+    stored_pme_reciprocal_cell = cell%reciprocal_cell
+    stored_pme_gaussian_width = gaussian_width
+
+  end subroutine update_pme_grid
+
+
+  ! Calculates the values and derivatives of cardinal B-splines.
+  !
+  ! The B-spline of order :math:`n` is defined recursively as
+  ! 
+  ! .. math::
+  !
+  !    M_n(x) = \frac{x}{n-1} M_{n-1}(x) + \frac{n-x}{n-1} M_{n-1}(x-1),
+  !
+  ! starting from :math:`M_2(x) = 1 - |x-1|` for :math:`0 \le x \le 2`. The 
+  ! function is nonzero in the interval :math:`0 < x < n`, and so for a point
+  ! :math:`u` on the grid only the :math:`n` grid points :math:`\lfloor u \rfloor - j`, 
+  ! :math:`j = 0,\ldots,n-1`, get a nonzero weight :math:`M_n(u - \lfloor u \rfloor + j)`.
+  !
+  ! *fraction the fractional part :math:`w = u - \lfloor u \rfloor` of the grid coordinate
+  ! *order the order of the B-spline
+  ! *weights the values :math:`M_n(w + j)`
+  ! *derivatives the derivatives :math:`M_n'(w + j) = M_{n-1}(w + j) - M_{n-1}(w + j - 1)`
+  subroutine pme_bspline_weights(fraction,order,weights,derivatives)
+    implicit none
+    double precision, intent(in) :: fraction
+    integer, intent(in) :: order
+    double precision, intent(out) :: weights(0:order-1), derivatives(0:order-1)
+    double precision :: previous
+    integer :: n, j
+
+    weights = 0.d0
+    derivatives = 0.d0
+    ! M_2(w) = w, M_2(w+1) = 1-w
+    weights(0) = fraction
+    weights(1) = 1.d0 - fraction
+    ! M_2'(x) = M_1(x) - M_1(x-1)
+    derivatives(0) = 1.d0
+    derivatives(1) = -1.d0
+
+    do n = 3, order
+       if(n == order)then
+          derivatives(0) = weights(0)
+          do j = 1, order-1
+             derivatives(j) = weights(j) - weights(j-1)
+          end do
+       end if
+       do j = n-1, 0, -1
+          if(j > 0)then
+             previous = weights(j-1)
+          else
+             previous = 0.d0
+          end if
+          weights(j) = ( (fraction+j)*weights(j) + (n-fraction-j)*previous ) / (n-1)
+       end do
+    end do
+
+  end subroutine pme_bspline_weights
+
+
+  ! Finds the grid points and B-spline weights for interpolating
+  ! a point charge on the particle mesh Ewald grid.
+  !
+  ! The scaled fractional coordinates :math:`u_j = K_j \mathbf{b}_j \cdot \mathbf{r} / 2 \pi`
+  ! of the atom are calculated, and the weights of the
+  ! grid points :math:`\lfloor u_j \rfloor - l`, :math:`l = 0,\ldots,n-1`, along each dimension 
+  ! are given by :func:`pme_bspline_weights`.
+  !
+  ! *position coordinates of the atom
+  ! *cell the supercell containing the system
+  ! *grid the number of grid points along each cell vector
+  ! *order the order of the B-splines
+  ! *points the indices of the grid points receiving nonzero weights, for each dimension
+  ! *weights the weights of the grid points, for each dimension
+  ! *derivatives the derivatives of the weights with respect to the atomic coordinates, for each dimension
+  subroutine pme_grid_weights(position,cell,grid,order,points,weights,derivatives)
+    implicit none
+    double precision, intent(in) :: position(3)
+    type(supercell), intent(in) :: cell
+    integer, intent(in) :: grid(3), order
+    integer, intent(out) :: points(0:order-1,3)
+    double precision, intent(out) :: weights(0:order-1,3), derivatives(0:order-1,3)
+    double precision :: u
+    integer :: dim, l, base
+
+    do dim = 1, 3
+       u = (cell%reciprocal_cell(1:3,dim) .o. position) / (2.d0*pi)
+       u = grid(dim) * (u - floor(u))
+       base = floor(u)
+       call pme_bspline_weights(u-base,order,weights(0:order-1,dim),derivatives(0:order-1,dim))
+       ! du/dr = K b / (2 pi), only the magnitude is stored here
+       derivatives(0:order-1,dim) = derivatives(0:order-1,dim) * grid(dim) / (2.d0*pi)
+       do l = 0, order-1
+          points(l,dim) = modulo(base-l,grid(dim))
+       end do
+    end do
+
+  end subroutine pme_grid_weights
+
+
+  ! Spreads the charges of the atoms on the particle mesh Ewald grid.
+  !
+  ! The grid charge is
+  !
+  ! .. math::
+  !
+  !    Q(\mathbf{k}) = \sum_i q_i \prod_{j=1}^3 M_n(u_{i,j} - k_j)
+  !
+  ! where the sum runs over the atoms and all their periodic images.
+  ! The result is stored in ``pme_charges``.
+  !
+  ! *atoms list of atoms
+  ! *cell the supercell containing the system
+  ! *grid the number of grid points along each cell vector
+  ! *order the order of the B-splines
+  ! *scaler a list of numerical values to scale the individual charges of the atoms
+  subroutine pme_spread_charges(atoms,cell,grid,order,scaler)
+    implicit none
+    type(atom), intent(in) :: atoms(:)
+    type(supercell), intent(in) :: cell
+    integer, intent(in) :: grid(3), order
+    double precision, intent(in) :: scaler(:)
+    integer :: index1, l1, l2, l3, points(0:order-1,3)
+    double precision :: charge1, weights(0:order-1,3), derivatives(0:order-1,3)
+
+    pme_tmp_charges = 0.d0
+
+    do index1 = 1, size(atoms)
+       if(is_my_atom(index1))then
+          charge1 = atoms(index1)%charge*scaler(index1)
+          if(charge1 /= 0.d0)then
+             call pme_grid_weights(atoms(index1)%position,cell,grid,order,points,weights,derivatives)
+             do l3 = 0, order-1
+                do l2 = 0, order-1
+                   do l1 = 0, order-1
+                      pme_tmp_charges(points(l1,1),points(l2,2),points(l3,3)) = &
+                           pme_tmp_charges(points(l1,1),points(l2,2),points(l3,3)) + &
+                           charge1 * weights(l1,1) * weights(l2,2) * weights(l3,3)
+                   end do
                 end do
              end do
-          end do
+          end if
        end if
     end do
 
 #ifdef MPI
+    ! collect the grid from all cpus in MPI
+    call mpi_allreduce(pme_tmp_charges,pme_charges,size(pme_charges),mpi_double_precision,&
+         mpi_sum,mpi_comm_world,mpistat)
+#else
+    pme_charges = pme_tmp_charges
+#endif
 
-	call timer(t2)
-	call record_load(t1+t2)
+  end subroutine pme_spread_charges
+
+
+  ! Calculates the reciprocal space potential on the particle mesh Ewald grid.
+  !
+  ! The grid charge :math:`Q` is Fourier transformed, multiplied
+  ! by the influence function :math:`G` and transformed back, yielding
+  !
+  ! .. math::
+  !
+  !    \phi(\mathbf{k}) = \sum_{\mathbf{m}} G(\mathbf{m}) F[Q](\mathbf{m}) e^{-2 \pi \mathrm{i} \sum_j m_j k_j / K_j},
+  !
+  ! where :math:`F[Q](\mathbf{m}) = \sum_{\mathbf{k}} Q(\mathbf{k}) e^{2 \pi \mathrm{i} \sum_j m_j k_j / K_j}`.
+  ! The potential is stored as the real part of ``pme_mesh``.
+  ! The reciprocal sum :math:`\sum_{\mathbf{m}} G(\mathbf{m}) |F[Q](\mathbf{m})|^2 = \sum_{\mathbf{k}} Q(\mathbf{k}) \phi(\mathbf{k})`
+  ! is also returned.
+  !
+  ! *reciprocal_sum the sum :math:`\sum_{\mathbf{m}} G(\mathbf{m}) |F[Q](\mathbf{m})|^2`
+  ! *potential if true, the potential is calculated, otherwise only the sum is evaluated
+  subroutine pme_convolution(reciprocal_sum,potential)
+    implicit none
+    double precision, intent(out) :: reciprocal_sum
+    logical, intent(in) :: potential
+
+    pme_mesh = cmplx(pme_charges, 0.d0, kind(1.d0))
+    call fft_3d(pme_mesh,1)
+
+    reciprocal_sum = sum( pme_influence * &
+         ( real(pme_mesh)*real(pme_mesh) + aimag(pme_mesh)*aimag(pme_mesh) ) )
+
+    if(potential)then
+       pme_mesh = pme_mesh * pme_influence
+       call fft_3d(pme_mesh,-1)
+    end if
+
+  end subroutine pme_convolution
+
+
+  ! Fast Fourier transform of a three dimensional complex grid.
+  !
+  ! Calculates the unnormalized transform 
+  ! :math:`X(\mathbf{m}) = \sum_{\mathbf{k}} x(\mathbf{k}) e^{\pm 2 \pi \mathrm{i} \sum_j m_j k_j / K_j}` 
+  ! in place, by transforming the grid one dimension at a time with :func:`fft_1d`.
+  !
+  ! *grid the grid to be transformed
+  ! *direction the sign of the exponent, 1 or -1
+  subroutine fft_3d(grid,direction)
+    implicit none
+    double complex, intent(inout) :: grid(0:,0:,0:)
+    integer, intent(in) :: direction
+    double complex, allocatable :: line(:), transformed(:), twiddles(:), work(:)
+    integer :: n(3), i1, i2, i3, dim
+
+    n = shape(grid)
+    allocate(line(0:maxval(n)-1))
+    allocate(transformed(0:maxval(n)-1))
+    allocate(twiddles(0:maxval(n)-1))
+    allocate(work(0:maxval(n)-1))
+
+    do dim = 1, 3
+       call fft_twiddle_factors(n(dim),direction,twiddles)
+       select case(dim)
+       case(1)
+          do i3 = 0, n(3)-1
+             do i2 = 0, n(2)-1
+                line(0:n(1)-1) = grid(:,i2,i3)
+                call fft_1d(n(1),line,transformed,twiddles,work)
+                grid(:,i2,i3) = transformed(0:n(1)-1)
+             end do
+          end do
+       case(2)
+          do i3 = 0, n(3)-1
+             do i1 = 0, n(1)-1
+                line(0:n(2)-1) = grid(i1,:,i3)
+                call fft_1d(n(2),line,transformed,twiddles,work)
+                grid(i1,:,i3) = transformed(0:n(2)-1)
+             end do
+          end do
+       case(3)
+          do i2 = 0, n(2)-1
+             do i1 = 0, n(1)-1
+                line(0:n(3)-1) = grid(i1,i2,:)
+                call fft_1d(n(3),line,transformed,twiddles,work)
+                grid(i1,i2,:) = transformed(0:n(3)-1)
+             end do
+          end do
+       end select
+    end do
+
+    deallocate(line)
+    deallocate(transformed)
+    deallocate(twiddles)
+    deallocate(work)
+
+  end subroutine fft_3d
+
+
+  ! Calculates the factors :math:`e^{\pm 2 \pi \mathrm{i} j / n}` needed in :func:`fft_1d`.
+  !
+  ! *n length of the transform
+  ! *direction the sign of the exponent, 1 or -1
+  ! *twiddles the calculated factors
+  subroutine fft_twiddle_factors(n,direction,twiddles)
+    implicit none
+    integer, intent(in) :: n, direction
+    double complex, intent(out) :: twiddles(0:)
+    double precision :: arg
+    integer :: j
+
+    do j = 0, n-1
+       arg = direction * 2.d0*pi*j / n
+       twiddles(j) = cmplx(cos(arg), sin(arg), kind(1.d0))
+    end do
+
+  end subroutine fft_twiddle_factors
+
+
+  ! One dimensional fast Fourier transform, 
+  ! :math:`y_m = \sum_k x_k e^{\pm 2 \pi \mathrm{i} m k / n}`.
+  !
+  ! The transform is calculated with the mixed radix Cooley-Tukey algorithm by 
+  ! :func:`fft_recursive` and works for any length, though it is fastest if the
+  ! length only has small prime factors.
+  !
+  ! *n length of the transform
+  ! *x the data to be transformed
+  ! *y the transformed data
+  ! *twiddles the factors :math:`e^{\pm 2 \pi \mathrm{i} j / n}` from :func:`fft_twiddle_factors`
+  ! *work work space of length n
+  subroutine fft_1d(n,x,y,twiddles,work)
+    implicit none
+    integer, intent(in) :: n
+    double complex, intent(in) :: x(0:), twiddles(0:)
+    double complex, intent(inout) :: y(0:), work(0:)
+
+    call fft_recursive(n,x,1,y,twiddles,1,work)
+
+  end subroutine fft_1d
+
+
+  ! The recursive step of the mixed radix fast Fourier transform.
+  !
+  ! The sequence :math:`x_0, x_s, \ldots, x_{(n-1)s}` of length :math:`n = p m` is split in :math:`p` 
+  ! interleaved subsequences of length :math:`m`, where :math:`p` is the smallest prime factor of :math:`n`.
+  ! These are transformed recursively and then combined.
+  !
+  ! *n length of the transform
+  ! *x the data to be transformed
+  ! *stride the stride :math:`s` between the elements of the data
+  ! *y the transformed data
+  ! *twiddles the factors :math:`e^{\pm 2 \pi \mathrm{i} j / N}` for the full transform of length :math:`N`
+  ! *twiddle_stride the ratio :math:`N/n`
+  ! *work work space
+  recursive subroutine fft_recursive(n,x,stride,y,twiddles,twiddle_stride,work)
+    implicit none
+    integer, intent(in) :: n, stride, twiddle_stride
+    double complex, intent(in) :: x(0:*), twiddles(0:*)
+    double complex, intent(inout) :: y(0:*), work(0:*)
+    double complex :: sum_q
+    integer :: p, m, r, q, k
+
+    if(n == 1)then
+       y(0) = x(0)
+       return
+    end if
+
+    ! smallest prime factor
+    p = 2
+    do while(mod(n,p) /= 0)
+       p = p + 1
+    end do
+    m = n / p
+
+    ! transform the subsequences x_r, x_{r+p}, ... into y(r*m:r*m+m-1)
+    do r = 0, p-1
+       call fft_recursive(m,x(r*stride),stride*p,y(r*m),twiddles,twiddle_stride*p,work)
+    end do
+
+    ! combine: y_{k+qm} = sum_r exp(i 2 pi r (k+qm)/n) Y^r_k
+    if(p == 2)then
+       do k = 0, m-1
+          sum_q = twiddles(k*twiddle_stride) * y(k+m)
+          y(k+m) = y(k) - sum_q
+          y(k) = y(k) + sum_q
+       end do
+    else
+       do k = 0, m-1
+          do r = 0, p-1
+             work(r) = twiddles(r*k*twiddle_stride) * y(k+r*m)
+          end do
+          do q = 0, p-1
+             sum_q = work(0)
+             do r = 1, p-1
+                sum_q = sum_q + work(r) * twiddles(mod(r*q,p)*m*twiddle_stride)
+             end do
+             y(k+q*m) = sum_q
+          end do
+       end do
+    end if
+
+  end subroutine fft_recursive
+
+
+  ! Calculates the energy due to long ranged :math:`\frac{1}{r}` potentials
+  ! using the smooth particle mesh Ewald method.
+  !
+  ! The method is the same as Ewald summation (see :func:`calculate_ewald_energy`)
+  ! except for the evaluation of the reciprocal space sum. Instead of summing
+  ! over the k-vectors explicitly, the charges are interpolated on a regular
+  ! grid with B-splines, 
+  !
+  ! .. math::
+  !
+  !    S(\mathbf{k}) \approx b_1(m_1) b_2(m_2) b_3(m_3) F[Q](\mathbf{m}),
+  !
+  ! where :math:`Q` is the grid charge (see :func:`pme_spread_charges`), :math:`F[Q]` its discrete 
+  ! Fourier transform and 
+  ! :math:`b_j(m) = e^{2 \pi \mathrm{i} (n-1) m / K_j} / \sum_{l=0}^{n-2} M_n(l+1) e^{2 \pi \mathrm{i} m l / K_j}`.
+  ! The reciprocal energy then becomes
+  !
+  ! .. math::
+  !
+  !    E_l = \frac{1}{2 V \varepsilon_0} \sum_{\mathbf{m} \ne 0} G(\mathbf{m}) |F[Q](\mathbf{m})|^2
+  !
+  ! with :math:`G` given by :func:`update_pme_grid`. The transforms are calculated with the fast 
+  ! Fourier transform, and so the cost of the method scales as :math:`\mathcal{O}(N + K \log K)`
+  ! for :math:`N` atoms and :math:`K` grid points.
+  !
+  ! The real space sum is not calculated, since in the main evaluation loop of the core
+  ! it is calculated together with the other pairwise interactions.
+  !
+  ! *atoms list of atoms
+  ! *cell the supercell containing the system
+  ! *grid the number of grid points along each cell vector
+  ! *order the order of the B-splines used for interpolating the charges on the grid
+  ! *gaussian_width The :math:`\sigma` parameter, i.e., the distribution width of the screening Gaussians.
+  ! *electric_constant The electic constant, i.e., vacuum permittivity :math:`\varepsilon_0`.
+  ! *scaler a list of numerical values to scale the individual charges of the atoms
+  ! *include_dipole_correction if true, a dipole correction term is included in the energy
+  ! *total_energy the calculated energy
+  subroutine calculate_pme_energy(atoms,cell,grid,order,gaussian_width,&
+       electric_constant,scaler,include_dipole_correction,total_energy)
+    implicit none
+    type(atom), intent(in) :: atoms(:)
+    type(supercell), intent(in) :: cell
+    integer, intent(in) :: grid(3), order
+    double precision, intent(in) :: gaussian_width, electric_constant, scaler(:)
+    double precision, intent(out) :: total_energy
+    logical, intent(in) :: include_dipole_correction
+    double precision :: energy(7), tmp_energy(7), charge1, inv_eps_2v, inv_eps_4pi, &
+         inv_sigma_sqrt_2pi, reciprocal_sum
+    integer :: index1
+
+    call update_pme_grid(cell,grid,order,gaussian_width)
+
+    energy = 0.d0
+    tmp_energy = 0.d0
+    total_energy = 0.d0
+
+    inv_eps_4pi = 1.d0 / (4.d0 * pi * electric_constant)
+    inv_eps_2v = 1.d0 / (2.d0 * cell%volume * electric_constant)
+    inv_sigma_sqrt_2pi = 1.d0 / (sqrt(2.d0 * pi) * gaussian_width)
+
+    call pme_spread_charges(atoms,cell,grid,order,scaler)
+
+    ! loop over atoms
+    do index1 = 1, size(atoms)
+       if(is_my_atom(index1))then
+          charge1 = atoms(index1)%charge*scaler(index1)
+          
+          ! self energy
+          energy(2) = energy(2) + charge1*charge1
+          ! charged background correction
+          energy(4) = energy(4) + charge1 
+          ! dipole correction
+          if(include_dipole_correction)then
+             energy(5:7) = energy(5:7) + charge1 * atoms(index1)%position(1:3)
+          end if
+       end if
+    end do
+
+#ifdef MPI
+    ! collect energies from all cpus in MPI (energy -> tmp_energy)
+    call mpi_allreduce(energy,tmp_energy,size(energy),mpi_double_precision,&
+         mpi_sum,mpi_comm_world,mpistat)
+#else
+    tmp_energy = energy
+#endif
+
+    !
+    ! calculate the reciprocal space sum
+    !
+    call pme_convolution(reciprocal_sum,.false.)
+
+    ! multiply with leading coefficients
+    energy(1) = 0.d0 ! real space
+    energy(2) = -tmp_energy(2) * inv_eps_4pi * inv_sigma_sqrt_2pi ! self energy
+    energy(3) = reciprocal_sum * inv_eps_2v ! reciprocal space
+    energy(4) = - tmp_energy(4)*tmp_energy(4) * 0.5d0 * inv_eps_2v * gaussian_width*gaussian_width ! charged background
+    energy(5) = (tmp_energy(5:7).o.tmp_energy(5:7)) * inv_eps_2v / 3.d0 ! dipole correction
+    energy(6) = 0.d0
+    energy(7) = 0.d0
+
+    total_energy = sum(energy)
+
+  end subroutine calculate_pme_energy
+
+
+  ! Calculates the forces due to long ranged :math:`\frac{1}{r}` potentials
+  ! using the smooth particle mesh Ewald method.
+  ! These forces are the gradients of the energies :math:`U` given by :func:`calculate_pme_energy`.
+  ! The reciprocal forces are obtained by differentiating the B-splines,
+  !
+  ! .. math::
+  !
+  !    \mathbf{F}_\alpha = - \frac{1}{V \varepsilon_0} q_\alpha \sum_{\mathbf{k}} \phi(\mathbf{k}) \nabla_\alpha \prod_{j=1}^3 M_n(u_{\alpha,j} - k_j),
+  !
+  ! where :math:`\phi` is the grid potential given by :func:`pme_convolution`.
+  ! As in :func:`calculate_pme_energy`, the real space sum is not calculated.
+  !
+  ! *atoms list of atoms
+  ! *cell the supercell containing the system
+  ! *grid the number of grid points along each cell vector
+  ! *order the order of the B-splines used for interpolating the charges on the grid
+  ! *gaussian_width The :math:`\sigma` parameter, i.e., the distribution width of the screening Gaussians.
+  ! *electric_constant The electic constant, i.e., vacuum permittivity :math:`\varepsilon_0`.
+  ! *scaler a list of numerical values to scale the individual charges of the atoms
+  ! *include_dipole_correction if true, a dipole correction term is included
+  ! *total_forces the calculated forces
+  ! *total_stress the calculated stress
+  subroutine calculate_pme_forces(atoms,cell,grid,order,gaussian_width,&
+       electric_constant,scaler,include_dipole_correction,total_forces,total_stress)
+    implicit none
+    type(atom), intent(in) :: atoms(:)
+    type(supercell), intent(in) :: cell
+    integer, intent(in) :: grid(3), order
+    double precision, intent(in) :: gaussian_width, electric_constant, scaler(:)
+    double precision, intent(inout) :: total_forces(:,:), total_stress(6)
+    logical, intent(in) :: include_dipole_correction
+    double precision :: charge1, inv_eps_2v, reciprocal_sum, potential, &
+         gradient(3), stress(6), dipole(3), tmp_dipole(3), &
+         weights(0:order-1,3), derivatives(0:order-1,3)
+    integer :: index1, n_atoms, l1, l2, l3, points(0:order-1,3)
+
+    n_atoms = size(atoms)
+    call update_pme_grid(cell,grid,order,gaussian_width)
+
+    ewald_forces = 0.d0
+    total_forces = 0.d0
+    stress = 0.d0
+    total_stress = 0.d0
+    dipole = 0.d0
+    tmp_dipole = 0.d0
+
+    inv_eps_2v = 1.d0 / (2.d0 * cell%volume * electric_constant)
+
+    call pme_spread_charges(atoms,cell,grid,order,scaler)
+    call pme_convolution(reciprocal_sum,.true.)
+
+    !
+    ! calculate the dipole correction terms
+    !
+    if(include_dipole_correction)then
+       do index1 = 1, n_atoms
+          if(is_my_atom(index1))then
+             tmp_dipole(1:3) = tmp_dipole(1:3) + atoms(index1)%charge*scaler(index1) * atoms(index1)%position(1:3)
+          end if
+       end do
+#ifdef MPI
+       call mpi_allreduce(tmp_dipole,dipole,size(dipole),mpi_double_precision,&
+            mpi_sum,mpi_comm_world,mpistat)
+#else
+       dipole = tmp_dipole
+#endif
+    end if
+
+    do index1 = 1, n_atoms
+       if(is_my_atom(index1))then
+          charge1 = atoms(index1)%charge*scaler(index1)
+
+          !
+          ! calculate the dipole correction
+          ! 
+          if(include_dipole_correction)then
+             ewald_forces(1:3,3,index1) = charge1 * inv_eps_2v / (-1.5d0) * dipole(1:3)
+          end if
+
+          !
+          ! calculate the reciprocal space sum
+          !
+          if(charge1 /= 0.d0)then
+             call pme_grid_weights(atoms(index1)%position,cell,grid,order,points,weights,derivatives)
+             gradient = 0.d0
+             do l3 = 0, order-1
+                do l2 = 0, order-1
+                   do l1 = 0, order-1
+                      potential = real(pme_mesh(points(l1,1),points(l2,2),points(l3,3)))
+                      ! d theta / d u_j
+                      gradient(1) = gradient(1) + potential * derivatives(l1,1) * weights(l2,2) * weights(l3,3)
+                      gradient(2) = gradient(2) + potential * weights(l1,1) * derivatives(l2,2) * weights(l3,3)
+                      gradient(3) = gradient(3) + potential * weights(l1,1) * weights(l2,2) * derivatives(l3,3)
+                   end do
+                end do
+             end do
+             ! - 2 q / (2 V eps) sum_k phi(k) sum_j d theta / d u_j K_j b_j / (2 pi)
+             ewald_forces(1:3,2,index1) = -2.d0 * inv_eps_2v * charge1 * &
+                  ( gradient(1) * cell%reciprocal_cell(1:3,1) + &
+                  gradient(2) * cell%reciprocal_cell(1:3,2) + &
+                  gradient(3) * cell%reciprocal_cell(1:3,3) )
+          end if
+
+          ! stress tensor
+          stress(1) = stress(1) + atoms(index1)%position(1) * (ewald_forces(1,2,index1) + ewald_forces(1,3,index1))
+          stress(2) = stress(2) + atoms(index1)%position(2) * (ewald_forces(2,2,index1) + ewald_forces(2,3,index1))
+          stress(3) = stress(3) + atoms(index1)%position(3) * (ewald_forces(3,2,index1) + ewald_forces(3,3,index1))
+          stress(4) = stress(4) + atoms(index1)%position(2) * (ewald_forces(3,2,index1) + ewald_forces(3,3,index1))
+          stress(5) = stress(5) + atoms(index1)%position(1) * (ewald_forces(3,2,index1) + ewald_forces(3,3,index1))
+          stress(6) = stress(6) + atoms(index1)%position(1) * (ewald_forces(2,2,index1) + ewald_forces(2,3,index1))
+
+       end if
+    end do
+
+#ifdef MPI
+    ! collect forces from all cpus in MPI
+    call mpi_allreduce(ewald_forces,ewald_sum_forces,size(ewald_forces),mpi_double_precision,&
+         mpi_sum,mpi_comm_world,mpistat)
+    total_forces(1:3,1:n_atoms) = ewald_sum_forces(1:3,2,1:n_atoms) + ewald_sum_forces(1:3,3,1:n_atoms)
+    ! collect stress tensor
+    call mpi_allreduce(stress,total_stress,size(stress),mpi_double_precision,&
+         mpi_sum,mpi_comm_world,mpistat)
+#else
+    total_forces(1:3,1:n_atoms) = ewald_forces(1:3,2,1:n_atoms) + ewald_forces(1:3,3,1:n_atoms)
+    total_stress = stress
+#endif
+
+  end subroutine calculate_pme_forces
+
+
+  ! Calculates the electronegativities due to long ranged :math:`\frac{1}{r}` potentials
+  ! using the smooth particle mesh Ewald method.
+  ! These electronegativities are the derivatives of the energies :math:`U` given by :func:`calculate_pme_energy`.
+  ! The reciprocal part is obtained by interpolating the grid potential :math:`\phi` given by 
+  ! :func:`pme_convolution` at the atomic positions.
+  ! As in :func:`calculate_pme_energy`, the real space sum is not calculated.
+  !
+  ! *atoms list of atoms
+  ! *cell the supercell containing the system
+  ! *grid the number of grid points along each cell vector
+  ! *order the order of the B-splines used for interpolating the charges on the grid
+  ! *gaussian_width The :math:`\sigma` parameter, i.e., the distribution width of the screening Gaussians.
+  ! *electric_constant The electic constant, i.e., vacuum permittivity :math:`\varepsilon_0`.
+  ! *scaler a list of numerical values to scale the individual charges of the atoms
+  ! *include_dipole_correction if true, a dipole correction term is included
+  ! *total_enegs the calculated electronegativities
+  subroutine calculate_pme_electronegativities(atoms,cell,grid,order,gaussian_width,&
+       electric_constant,scaler,include_dipole_correction,total_enegs)
+    implicit none
+    type(atom), intent(in) :: atoms(:)
+    type(supercell), intent(in) :: cell
+    integer, intent(in) :: grid(3), order
+    double precision, intent(in) :: gaussian_width, electric_constant, scaler(:)
+    double precision, intent(inout) :: total_enegs(:)
+    logical, intent(in) :: include_dipole_correction
+    double precision :: qsum(4), tmp_qsum(4), charge1, inv_eps_2v, inv_eps_4pi, &
+         inv_sigma_sqrt_2pi, reciprocal_sum, potential, &
+         weights(0:order-1,3), derivatives(0:order-1,3)
+    integer :: index1, n_atoms, l1, l2, l3, points(0:order-1,3)
+
+    n_atoms = size(atoms)
+    call update_pme_grid(cell,grid,order,gaussian_width)
+
+    ewald_tmp_enegs = 0.d0
+    total_enegs = 0.d0
+    qsum = 0.d0
+    tmp_qsum = 0.d0
+
+    inv_eps_4pi = 1.d0 / (4.d0 * pi * electric_constant)
+    inv_eps_2v = 1.d0 / (2.d0 * cell%volume * electric_constant)
+    inv_sigma_sqrt_2pi = 1.d0 / (sqrt(2.d0 * pi) * gaussian_width)
+
+    call pme_spread_charges(atoms,cell,grid,order,scaler)
+    call pme_convolution(reciprocal_sum,.true.)
+
+    do index1 = 1, n_atoms
+       if(is_my_atom(index1))then
+          charge1 = atoms(index1)%charge*scaler(index1)
+
+          !
+          ! calculate the self energy term
+          !
+          ewald_tmp_enegs(index1) = ewald_tmp_enegs(index1) + 2.d0*charge1 * inv_eps_4pi * inv_sigma_sqrt_2pi 
+
+          !
+          ! calculate the total charge (charged background term)
+          !
+          tmp_qsum(1) = tmp_qsum(1) + charge1 
+          
+          !
+          ! calculate the dipole correction
+          !
+          if(include_dipole_correction)then
+             tmp_qsum(2:4) = tmp_qsum(2:4) + charge1 * atoms(index1)%position(1:3)
+          end if
+       end if
+    end do
+
+#ifdef MPI
+    call mpi_allreduce(tmp_qsum,qsum,size(qsum),mpi_double_precision,&
+         mpi_sum,mpi_comm_world,mpistat)
+#else
+    qsum = tmp_qsum
+#endif
+
+    do index1 = 1, n_atoms
+       if(is_my_atom(index1))then
+
+          !
+          ! calculate the total charged background and dipole correction terms
+          !
+          ewald_tmp_enegs(index1) = ewald_tmp_enegs(index1) - scaler(index1) * inv_eps_2v * &
+               ( - gaussian_width*gaussian_width *qsum(1) )
+          
+          if(include_dipole_correction)then
+             ewald_tmp_enegs(index1) = ewald_tmp_enegs(index1) + scaler(index1) * inv_eps_2v * &
+                  ( -0.666666666666666667d0 ) * &
+                  ( atoms(index1)%position(1:3) .o. qsum(2:4) )
+          end if
+
+          !
+          ! calculate the reciprocal space sum
+          !
+          call pme_grid_weights(atoms(index1)%position,cell,grid,order,points,weights,derivatives)
+          potential = 0.d0
+          do l3 = 0, order-1
+             do l2 = 0, order-1
+                do l1 = 0, order-1
+                   potential = potential + real(pme_mesh(points(l1,1),points(l2,2),points(l3,3))) * &
+                        weights(l1,1) * weights(l2,2) * weights(l3,3)
+                end do
+             end do
+          end do
+          ! - 2 / (2 V eps) sum_k phi(k) theta(k)
+          ewald_tmp_enegs(index1) = ewald_tmp_enegs(index1) - 2.d0 * inv_eps_2v * potential
+       end if
+    end do
 
+#ifdef MPI
     ! collect electronegativities from all cpus in MPI
     call mpi_allreduce(ewald_tmp_enegs,total_enegs,size(ewald_tmp_enegs),mpi_double_precision,&
          mpi_sum,mpi_comm_world,mpistat)
@@ -2246,7 +3234,8 @@ contains
     total_enegs = ewald_tmp_enegs
 #endif
 
-  end subroutine calculate_ewald_electronegativities
+  end subroutine calculate_pme_electronegativities
+
 
 
 
@@ -2326,6 +3315,113 @@ contains
 
 
 
+  ! !!!: add_stored_table
+
+  ! Stores a table of values in :data:`stored_tables`.
+  !
+  ! The table is given transposed with respect to the stored table, 
+  ! i.e., the values and the scaled derivatives are given as rows, 
+  ! so that arrays in the row major order of the Python interface can be passed without copying.
+  ! A table already stored at the given index is replaced. Potentials and
+  ! bond order factors point to the stored tables, so a table may only be replaced
+  ! or removed when it is no longer used.
+  !
+  ! *index the index of the stored table
+  ! *n_values the number of tabulated values
+  ! *values the tabulated values and scaled derivatives
+  subroutine add_stored_table(index,n_values,values)
+    implicit none
+    integer, intent(in) :: index, n_values
+    double precision, intent(in) :: values(2,n_values)
+    type(stored_table), allocatable :: tmp(:)
+    integer :: i
+
+    if(index < 1)then
+       return
+    end if
+
+    if(index > n_stored_tables)then
+       allocate(tmp(index))
+       do i = 1, n_stored_tables
+          tmp(i)%values => stored_tables(i)%values
+       end do
+       do i = n_stored_tables+1, index
+          nullify(tmp(i)%values)
+       end do
+       if(allocated(stored_tables))then
+          deallocate(stored_tables)
+       end if
+       call move_alloc(tmp,stored_tables)
+       n_stored_tables = index
+    end if
+
+    call remove_stored_table(index)
+    allocate(stored_tables(index)%values(n_values,2))
+    stored_tables(index)%values = transpose(values)
+
+  end subroutine add_stored_table
+
+
+  ! Releases the memory of a table in :data:`stored_tables`.
+  !
+  ! *index the index of the stored table
+  subroutine remove_stored_table(index)
+    implicit none
+    integer, intent(in) :: index
+
+    if(index < 1 .or. index > n_stored_tables)then
+       return
+    end if
+    if(associated(stored_tables(index)%values))then
+       deallocate(stored_tables(index)%values)
+    end if
+    nullify(stored_tables(index)%values)
+
+  end subroutine remove_stored_table
+
+
+  ! Releases the memory of all the tables in :data:`stored_tables`.
+  subroutine clear_stored_tables()
+    implicit none
+    integer :: i
+
+    do i = 1, n_stored_tables
+       call remove_stored_table(i)
+    end do
+    if(allocated(stored_tables))then
+       deallocate(stored_tables)
+    end if
+    n_stored_tables = 0
+
+  end subroutine clear_stored_tables
+
+
+  ! Points the given pointer to a table in :data:`stored_tables`.
+  !
+  ! *index the index of the stored table
+  ! *table the pointer to be associated with the stored table
+  ! *success logical tag specifying if the table was found
+  subroutine get_stored_table(index,table,success)
+    implicit none
+    integer, intent(in) :: index
+    double precision, pointer :: table(:,:)
+    logical, intent(out) :: success
+
+    success = .false.
+    nullify(table)
+    if(index < 1 .or. index > n_stored_tables)then
+       return
+    end if
+    if(.not. associated(stored_tables(index)%values))then
+       return
+    end if
+    table => stored_tables(index)%values
+    success = .true.
+
+  end subroutine get_stored_table
+
+
+
   ! !!!: create_potential
 
   ! Returns a :data:`potential`.
@@ -2407,6 +3503,7 @@ contains
     new_potential%original_tags = orig_tags
     new_potential%original_indices = orig_indices
     new_potential%pot_index = pot_index
+    new_potential%derivative_parameter = 0
 
     if(n_targets >= 1)then
 
@@ -2458,11 +3555,18 @@ contains
     end select
 
     ! read a table of values for the tabulated potential
+    new_potential%shared_table = .false.
     select case (new_potential%type_index)
     case(pair_table_index) ! tabulated
        nullify(new_potential%table)
-       write(tablefile,'(A6,I4.4,A4)') table_prefix, int(parameters(1)), table_suffix
-       call read_table(tablefile,new_potential%table,success)
+       if(parameters(1) < 0.d0)then
+          ! negative ids refer to the tables stored in the core
+          call get_stored_table(-nint(parameters(1)),new_potential%table,success)
+          new_potential%shared_table = success
+       else
+          write(tablefile,'(A6,I4.4,A4)') table_prefix, int(parameters(1)), table_suffix
+          call read_table(tablefile,new_potential%table,success)
+       end if
     case default
        nullify(new_potential%table)
        allocate(new_potential%table(0,0))
@@ -2473,6 +3577,65 @@ contains
 
 
 
+  ! Replaces the numeric parameters of an existing :data:`potential`.
+  !
+  ! The parameters are overwritten in place, so all potentials sharing
+  ! the same parameter storage, such as the multipliers copied to the
+  ! components of a product potential, are updated at once.
+  ! Derived parameters are recalculated.
+  ! Since tabulated potentials read their values from a file, their
+  ! table cannot be changed this way.
+  !
+  ! *n_params number of parameters
+  ! *parameters the new numeric parameters
+  ! *the_potential the potential to be updated
+  ! *success logical tag specifying if the update succeeded
+  subroutine update_potential_parameters(n_params,parameters,the_potential,success)
+    implicit none
+    integer, intent(in) :: n_params
+    double precision, intent(in) :: parameters(n_params)
+    type(potential), intent(inout) :: the_potential
+    logical, intent(out) :: success
+    type(potential) :: derived
+
+    success = .false.
+    if(size(the_potential%parameters) /= n_params)then
+       return
+    end if
+    if(the_potential%type_index == pair_table_index)then
+       if(parameters(1) /= the_potential%parameters(1))then
+          return
+       end if
+    end if
+
+    the_potential%parameters(1:n_params) = parameters(1:n_params)
+
+    !*********************************!
+    ! EDIT WHEN ADDING NEW POTENTIALS !
+    !*********************************!
+
+    ! the derived parameters are calculated in a temporary potential
+    ! and copied in the existing storage
+    select case (the_potential%type_index)
+    case(tri_bend_index) ! bond bending
+       call calculate_derived_parameters_bond_bending(n_params,parameters,derived)
+    case(pair_qexp_index) ! charge-dep. exp.
+       call calculate_derived_parameters_charge_exp(n_params,parameters,derived)
+    case(quad_dihedral_index) ! dihedral angle
+       call calculate_derived_parameters_dihedral(n_params,parameters,derived)
+    case default
+       success = .true.
+       return
+    end select
+
+    the_potential%derived_parameters(:) = derived%derived_parameters(:)
+    deallocate(derived%derived_parameters)
+    success = .true.
+
+  end subroutine update_potential_parameters
+
+
+
   !***********************************!
   !                                   !
   ! Routines for choosing the correct !
@@ -2647,6 +3810,12 @@ contains
     double precision :: multi_energy(n_product), multi_force(3,n_targets,n_product), energy, tmp_energy
     integer :: i, j
 
+    if(parameter_derivative_mode)then
+       call evaluate_force_parameter_derivative(n_targets,n_product,separations,distances,interaction,&
+            force,atoms)
+       return
+    end if
+
     if(n_product > 1)then
        call evaluate_energy_component(n_targets,separations,distances,interaction,&
             multi_energy(1),atoms)
@@ -2798,6 +3967,12 @@ contains
     double precision :: multi_energy(n_product)
     integer :: i
 
+    if(parameter_derivative_mode)then
+       call evaluate_energy_parameter_derivative(n_targets,n_product,separations,distances,interaction,&
+            energy,atoms)
+       return
+    end if
+
     call evaluate_energy_component(n_targets,separations,distances,interaction,&
          multi_energy(1),atoms)
 
@@ -2892,6 +4067,447 @@ contains
 
 
 
+  ! Evaluates the derivative of the energy due to an interaction between the given
+  ! atoms with respect to a parameter of the interaction. 
+  ! This is the counterpart of :func:`evaluate_energy` in the parameter derivative mode.
+  !
+  ! The parameter is marked by the derivative_parameter of the :data:`potential`.
+  ! For a product potential, the parameter may belong to the potential or to one of its multipliers,
+  ! and the derivative is obtained by the product rule. If no parameter is marked,
+  ! the derivative is zero.
+  !
+  ! *n_targets number of targets
+  ! *n_product number of potentials in the product
+  ! *separations atom-atom separation vectors :math:`\mathrm{r}_{12}`, :math:`\mathrm{r}_{23}` etc. for the atoms 123...
+  ! *distances atom-atom distances :math:`r_{12}`, :math:`r_{23}` etc. for the atoms 123..., i.e., the norms of the separation vectors.
+  ! *interaction a :data:`potential` containing the parameters
+  ! *atoms a list of the actual :data:`atom` objects for which the term is calculated
+  ! *energy the calculated derivative :math:`\partial v_{ijk} / \partial p`
+  subroutine evaluate_energy_parameter_derivative(n_targets,n_product,separations,distances,interaction,energy,atoms)
+    implicit none
+    integer, intent(in) :: n_targets, n_product
+    double precision, intent(in) :: separations(3,n_targets-1), distances(n_targets-1)
+    type(potential), intent(in) :: interaction
+    double precision, intent(out) :: energy
+    type(atom), intent(in) :: atoms(n_targets)
+    double precision :: multi_energy(n_product)
+    integer :: i, marked
+
+    energy = 0.d0
+    marked = 0
+    if(interaction%derivative_parameter > 0)then
+       marked = 1
+    end if
+    do i = 1, n_product-1
+       if(interaction%multipliers(i)%derivative_parameter > 0)then
+          marked = i+1
+       end if
+    end do
+    if(marked == 0)then
+       return
+    end if
+
+    if(marked == 1)then
+       call evaluate_energy_parameter_derivative_component(n_targets,separations,distances,interaction,&
+            interaction%derivative_parameter,multi_energy(1),atoms)
+    else
+       call evaluate_energy_component(n_targets,separations,distances,interaction,&
+            multi_energy(1),atoms)
+    end if
+    do i = 1, n_product-1
+       if(marked == i+1)then
+          call evaluate_energy_parameter_derivative_component(n_targets,separations,distances,&
+               interaction%multipliers(i),interaction%multipliers(i)%derivative_parameter,&
+               multi_energy(i+1),atoms)
+       else
+          call evaluate_energy_component(n_targets,separations,distances,interaction%multipliers(i),&
+               multi_energy(i+1),atoms)
+       end if
+    end do
+
+    energy = 1.d0
+    do i = 1, n_product
+       energy = energy * multi_energy(i)
+    end do
+
+  end subroutine evaluate_energy_parameter_derivative
+
+
+
+  ! Evaluates the derivative of the forces due to an interaction between the given
+  ! atoms with respect to a parameter of the interaction.
+  ! This is the counterpart of :func:`evaluate_forces` in the parameter derivative mode.
+  !
+  ! As in :func:`evaluate_energy_parameter_derivative`, the parameter is marked by the
+  ! derivative_parameter of the :data:`potential` or one of its multipliers.
+  !
+  ! *n_targets number of targets
+  ! *n_product number of potentials in the product
+  ! *separations atom-atom separation vectors :math:`\mathrm{r}_{12}`, :math:`\mathrm{r}_{23}` etc. for the atoms 123...
+  ! *distances atom-atom distances :math:`r_{12}`, :math:`r_{23}` etc. for the atoms 123..., i.e., the norms of the separation vectors.
+  ! *interaction a :data:`potential` containing the parameters
+  ! *atoms a list of the actual :data:`atom` objects for which the term is calculated
+  ! *force the calculated derivative :math:`\partial \mathbf{f}_{\alpha,ijk} / \partial p`
+  subroutine evaluate_force_parameter_derivative(n_targets,n_product,separations,distances,interaction,force,atoms)
+    implicit none
+    integer, intent(in) :: n_targets, n_product
+    double precision, intent(in) :: separations(3,n_targets-1), distances(n_targets-1)
+    type(potential), intent(in) :: interaction
+    double precision, intent(out) :: force(3,n_targets)
+    type(atom), intent(in) :: atoms(n_targets)
+    double precision :: multi_energy(n_product), multi_force(3,n_targets,n_product), tmp_energy
+    integer :: i, j, marked
+
+    force = 0.d0
+    marked = 0
+    if(interaction%derivative_parameter > 0)then
+       marked = 1
+    end if
+    do i = 1, n_product-1
+       if(interaction%multipliers(i)%derivative_parameter > 0)then
+          marked = i+1
+       end if
+    end do
+    if(marked == 0)then
+       return
+    end if
+
+    if(n_product == 1)then
+       call evaluate_force_parameter_derivative_component(n_targets,separations,distances,interaction,&
+            interaction%derivative_parameter,force,atoms)
+       return
+    end if
+
+    if(marked == 1)then
+       call evaluate_energy_parameter_derivative_component(n_targets,separations,distances,interaction,&
+            interaction%derivative_parameter,multi_energy(1),atoms)
+       call evaluate_force_parameter_derivative_component(n_targets,separations,distances,interaction,&
+            interaction%derivative_parameter,multi_force(1:3,1:n_targets,1),atoms)
+    else
+       call evaluate_energy_component(n_targets,separations,distances,interaction,&
+            multi_energy(1),atoms)
+       call evaluate_force_component(n_targets,separations,distances,interaction,&
+            multi_force(1:3,1:n_targets,1),atoms)
+    end if
+    do i = 1, n_product-1
+       if(marked == i+1)then
+          call evaluate_energy_parameter_derivative_component(n_targets,separations,distances,&
+               interaction%multipliers(i),interaction%multipliers(i)%derivative_parameter,&
+               multi_energy(i+1),atoms)
+          call evaluate_force_parameter_derivative_component(n_targets,separations,distances,&
+               interaction%multipliers(i),interaction%multipliers(i)%derivative_parameter,&
+               multi_force(1:3,1:n_targets,i+1),atoms)
+       else
+          call evaluate_energy_component(n_targets,separations,distances,interaction%multipliers(i),&
+               multi_energy(i+1),atoms)
+          call evaluate_force_component(n_targets,separations,distances,interaction%multipliers(i),&
+               multi_force(1:3,1:n_targets,i+1),atoms)
+       end if
+    end do
+
+    ! product rule
+    do i = 1, n_product
+       tmp_energy = 1.d0
+       do j = 1, n_product
+          if(i /= j)then
+             tmp_energy = tmp_energy * multi_energy(j)
+          end if
+       end do
+       force(1:3,1:n_targets) = force(1:3,1:n_targets) + &
+            tmp_energy * multi_force(1:3,1:n_targets,i)
+    end do
+
+  end subroutine evaluate_force_parameter_derivative
+
+
+
+  ! Evaluates the derivative of an elemental energy :math:`v_{\alpha,ijk}` 
+  ! with respect to one of its parameters.
+  !
+  ! The derivatives are calculated analytically for the potentials whose
+  ! energy is a simple closed-form function of the parameters. For the other
+  ! potentials, the derivative is obtained by differentiating the elemental
+  ! energy numerically with respect to the parameter, which only requires
+  ! evaluating the same term twice.
+  !
+  ! *n_targets number of targets
+  ! *separations atom-atom separation vectors :math:`\mathrm{r}_{12}`, :math:`\mathrm{r}_{23}` etc. for the atoms 123...
+  ! *distances atom-atom distances :math:`r_{12}`, :math:`r_{23}` etc. for the atoms 123..., i.e., the norms of the separation vectors.
+  ! *interaction a :data:`potential` containing the parameters
+  ! *param index of the parameter
+  ! *atoms a list of the actual :data:`atom` objects for which the term is calculated
+  ! *denergy the calculated derivative :math:`\partial v_{\alpha,ijk} / \partial p`
+  subroutine evaluate_energy_parameter_derivative_component(n_targets,separations,distances,interaction,&
+       param,denergy,atoms)
+    implicit none
+    integer, intent(in) :: n_targets, param
+    double precision, intent(in) :: separations(3,n_targets-1), distances(n_targets-1)
+    type(potential), intent(in) :: interaction
+    double precision, intent(out) :: denergy
+    type(atom), intent(in) :: atoms(n_targets)
+    type(potential) :: shifted
+    double precision :: r1, r2, r6, ratio, expo, energy_up, energy_down, shift
+    double precision, allocatable :: values(:)
+    logical :: success, discrete
+
+    denergy = 0.d0
+
+    !*********************************!
+    ! EDIT WHEN ADDING NEW POTENTIALS !
+    !*********************************!
+
+    select case (interaction%type_index)
+    case (pair_lj_index) ! lennard-jones: epsilon ( (sigma/r)^12 - (sigma/r)^6 )
+       ratio = interaction%parameters(2) / distances(1)
+       r6 = ratio*ratio*ratio*ratio*ratio*ratio
+       select case (param)
+       case (1)
+          denergy = r6*r6 - r6
+       case (2)
+          denergy = interaction%parameters(1) * (12.d0*r6*r6 - 6.d0*r6) / interaction%parameters(2)
+       end select
+    case (pair_spring_index) ! spring: k/2 ( (r-R_0)^2 - (r_c-R_0)^2 )
+       r2 = distances(1) - interaction%parameters(2)
+       r6 = interaction%cutoff - interaction%parameters(2)
+       if(r2*r2 < r6*r6)then
+          select case (param)
+          case (1)
+             denergy = 0.5d0 * (r2*r2 - r6*r6)
+          case (2)
+             denergy = interaction%parameters(1) * (r6 - r2)
+          end select
+       end if
+    case (pair_exp_index) ! exponential: epsilon exp(-zeta r)
+       expo = exp( -interaction%parameters(2)*distances(1) )
+       select case (param)
+       case (1)
+          denergy = expo
+       case (2)
+          denergy = -distances(1) * interaction%parameters(1) * expo
+       end select
+    case (pair_buck_index) ! buckingham: A exp(-r/sigma) - C (sigma/r)^6
+       ratio = distances(1) / interaction%parameters(3)
+       r6 = 1.d0 / (ratio*ratio*ratio*ratio*ratio*ratio)
+       expo = exp(-ratio)
+       select case (param)
+       case (1)
+          denergy = expo
+       case (2)
+          denergy = -r6
+       case (3)
+          denergy = ( interaction%parameters(1) * ratio * expo - &
+               6.d0 * interaction%parameters(2) * r6 ) / interaction%parameters(3)
+       end select
+    case (pair_power_index) ! power: epsilon (a/r)^n
+       ratio = interaction%parameters(2) / distances(1)
+       r1 = ratio**interaction%parameters(3)
+       select case (param)
+       case (1)
+          denergy = r1
+       case (2)
+          denergy = interaction%parameters(1) * interaction%parameters(3) * r1 / interaction%parameters(2)
+       case (3)
+          denergy = interaction%parameters(1) * r1 * log(ratio)
+       end select
+    case (mono_none_index) ! constant potential: V
+       denergy = 1.d0
+    case (mono_const_index) ! constant force: - F . r
+       denergy = - atoms(1)%position(param)
+    case default
+       ! discrete parameters cannot be differentiated, so their derivative is left zero
+       call check_discrete_parameter(interaction%type_index,param,discrete)
+       if(discrete)then
+          return
+       end if
+       ! numeric derivative of the elemental term
+       call copy_potential_parameters(interaction,shifted)
+       allocate(values(size(interaction%parameters)))
+       shift = 1.d-6 * max( abs(interaction%parameters(param)), 1.d0 )
+       values = interaction%parameters
+       values(param) = interaction%parameters(param) + shift
+       call update_potential_parameters(size(values),values,shifted,success)
+       if(success)then
+          call evaluate_energy_component(n_targets,separations,distances,shifted,energy_up,atoms)
+          values(param) = interaction%parameters(param) - shift
+          call update_potential_parameters(size(values),values,shifted,success)
+          call evaluate_energy_component(n_targets,separations,distances,shifted,energy_down,atoms)
+          denergy = (energy_up - energy_down) / (2.d0*shift)
+       end if
+       deallocate(values)
+       deallocate(shifted%parameters)
+       deallocate(shifted%derived_parameters)
+    end select
+
+  end subroutine evaluate_energy_parameter_derivative_component
+
+
+
+  ! Evaluates the derivative of an elemental force :math:`\mathbf{f}_{\alpha,ijk}` 
+  ! with respect to one of the parameters of the potential.
+  !
+  ! As in :func:`evaluate_energy_parameter_derivative_component`, the derivatives are
+  ! analytic for simple potentials and numeric for the others.
+  !
+  ! *n_targets number of targets
+  ! *separations atom-atom separation vectors :math:`\mathrm{r}_{12}`, :math:`\mathrm{r}_{23}` etc. for the atoms 123...
+  ! *distances atom-atom distances :math:`r_{12}`, :math:`r_{23}` etc. for the atoms 123..., i.e., the norms of the separation vectors.
+  ! *interaction a :data:`potential` containing the parameters
+  ! *param index of the parameter
+  ! *atoms a list of the actual :data:`atom` objects for which the term is calculated
+  ! *dforce the calculated derivative :math:`\partial \mathbf{f}_{\alpha,ijk} / \partial p`
+  subroutine evaluate_force_parameter_derivative_component(n_targets,separations,distances,interaction,&
+       param,dforce,atoms)
+    implicit none
+    integer, intent(in) :: n_targets, param
+    double precision, intent(in) :: separations(3,n_targets-1), distances(n_targets-1)
+    type(potential), intent(in) :: interaction
+    double precision, intent(out) :: dforce(3,n_targets)
+    type(atom), intent(in) :: atoms(n_targets)
+    type(potential) :: shifted
+    double precision :: r1, r2, r6, ratio, expo, shift, n, &
+         force_up(3,n_targets), force_down(3,n_targets)
+    double precision, allocatable :: values(:)
+    logical :: success, discrete
+
+    dforce = 0.d0
+    if(minval(distances(:)) == 0.d0)then
+       return
+    end if
+
+    !*********************************!
+    ! EDIT WHEN ADDING NEW POTENTIALS !
+    !*********************************!
+
+    select case (interaction%type_index)
+    case (pair_lj_index) ! lennard-jones
+       r1 = distances(1)
+       ratio = interaction%parameters(2) / r1
+       r6 = ratio*ratio*ratio*ratio*ratio*ratio
+       select case (param)
+       case (1)
+          dforce(1:3,1) = ( 6.d0*r6 - 12.d0*r6*r6 ) * separations(1:3,1) / (r1*r1)
+       case (2)
+          dforce(1:3,1) = interaction%parameters(1) * ( 36.d0*r6 - 144.d0*r6*r6 ) / interaction%parameters(2) * &
+               separations(1:3,1) / (r1*r1)
+       end select
+       dforce(1:3,2) = -dforce(1:3,1)
+    case (pair_spring_index) ! spring
+       r1 = distances(1)
+       r2 = r1 - interaction%parameters(2)
+       r6 = interaction%cutoff - interaction%parameters(2)
+       if(r2*r2 < r6*r6)then
+          select case (param)
+          case (1)
+             dforce(1:3,1) = r2 * separations(1:3,1) / r1
+          case (2)
+             dforce(1:3,1) = -interaction%parameters(1) * separations(1:3,1) / r1
+          end select
+          dforce(1:3,2) = -dforce(1:3,1)
+       end if
+    case (pair_exp_index) ! exponential
+       r1 = distances(1)
+       expo = exp( -interaction%parameters(2)*r1 )
+       select case (param)
+       case (1)
+          dforce(1:3,1) = -interaction%parameters(2) * expo * separations(1:3,1) / r1
+       case (2)
+          dforce(1:3,1) = interaction%parameters(1) * expo * (interaction%parameters(2)*r1 - 1.d0) * &
+               separations(1:3,1) / r1
+       end select
+       dforce(1:3,2) = -dforce(1:3,1)
+    case (pair_buck_index) ! buckingham
+       r1 = distances(1)
+       ratio = r1 / interaction%parameters(3)
+       r6 = 1.d0 / (ratio*ratio*ratio*ratio*ratio*ratio)
+       expo = exp(-ratio)
+       select case (param)
+       case (1)
+          dforce(1:3,1) = -ratio * expo * separations(1:3,1) / (r1*r1)
+       case (2)
+          dforce(1:3,1) = 6.d0 * r6 * separations(1:3,1) / (r1*r1)
+       case (3)
+          dforce(1:3,1) = ( interaction%parameters(1) * ratio * expo * (1.d0 - ratio) + &
+               36.d0 * interaction%parameters(2) * r6 ) / interaction%parameters(3) * &
+               separations(1:3,1) / (r1*r1)
+       end select
+       dforce(1:3,2) = -dforce(1:3,1)
+    case (pair_power_index) ! power
+       r1 = distances(1)
+       n = interaction%parameters(3)
+       ratio = interaction%parameters(2) / r1
+       r2 = ratio**n
+       select case (param)
+       case (1)
+          dforce(1:3,1) = -n * r2 * separations(1:3,1) / (r1*r1)
+       case (2)
+          dforce(1:3,1) = -interaction%parameters(1) * n * n * r2 / interaction%parameters(2) * &
+               separations(1:3,1) / (r1*r1)
+       case (3)
+          dforce(1:3,1) = -interaction%parameters(1) * r2 * (1.d0 + n*log(ratio)) * &
+               separations(1:3,1) / (r1*r1)
+       end select
+       dforce(1:3,2) = -dforce(1:3,1)
+    case (mono_none_index) ! constant potential
+       dforce = 0.d0
+    case (mono_const_index) ! constant force
+       dforce(param,1) = 1.d0
+    case default
+       ! discrete parameters cannot be differentiated, so their derivative is left zero
+       call check_discrete_parameter(interaction%type_index,param,discrete)
+       if(discrete)then
+          return
+       end if
+       ! numeric derivative of the elemental term
+       call copy_potential_parameters(interaction,shifted)
+       allocate(values(size(interaction%parameters)))
+       shift = 1.d-6 * max( abs(interaction%parameters(param)), 1.d0 )
+       values = interaction%parameters
+       values(param) = interaction%parameters(param) + shift
+       call update_potential_parameters(size(values),values,shifted,success)
+       if(success)then
+          call evaluate_force_component(n_targets,separations,distances,shifted,force_up,atoms)
+          values(param) = interaction%parameters(param) - shift
+          call update_potential_parameters(size(values),values,shifted,success)
+          call evaluate_force_component(n_targets,separations,distances,shifted,force_down,atoms)
+          dforce = (force_up - force_down) / (2.d0*shift)
+       end if
+       deallocate(values)
+       deallocate(shifted%parameters)
+       deallocate(shifted%derived_parameters)
+    end select
+
+  end subroutine evaluate_force_parameter_derivative_component
+
+
+
+  ! Copies a :data:`potential` so that the copy has its own parameter storage.
+  !
+  ! A plain assignment copies the pointers to the parameters, so changing the
+  ! parameters of the copy would change the original. Here the parameters
+  ! and the derived parameters are allocated anew, while the rest of the data,
+  ! such as the targets and the table, is shared with the original.
+  ! The parameters of the copy must be deallocated after use.
+  !
+  ! *original the potential to be copied
+  ! *the_copy the copy
+  subroutine copy_potential_parameters(original,the_copy)
+    implicit none
+    type(potential), intent(in) :: original
+    type(potential), intent(out) :: the_copy
+
+    the_copy = original
+    nullify(the_copy%parameters)
+    nullify(the_copy%derived_parameters)
+    allocate(the_copy%parameters(size(original%parameters)))
+    allocate(the_copy%derived_parameters(size(original%derived_parameters)))
+    the_copy%parameters = original%parameters
+    the_copy%derived_parameters = original%derived_parameters
+
+  end subroutine copy_potential_parameters
+
+
+
+
 
   !*************************************!
   !                                     !
@@ -5198,15 +6814,18 @@ contains
 
 
     ! read a table of values for the tabulated factor
+    new_bond%shared_table = .false.
     select case (new_bond%type_index)
-    case(table_bond_index) ! tabulated
-       nullify(new_bond%table)
-       write(tablefile,'(A6,I4.4,A4)') table_prefix, int(parameters(1)), table_suffix
-       call read_table(tablefile,new_bond%table,success)
-    case(table_scale_index) ! tabulated
+    case(table_bond_index, table_scale_index) ! tabulated
        nullify(new_bond%table)
-       write(tablefile,'(A6,I4.4,A4)') table_prefix, int(parameters(1)), table_suffix
-       call read_table(tablefile,new_bond%table,success)
+       if(parameters(1) < 0.d0)then
+          ! negative ids refer to the tables stored in the core
+          call get_stored_table(-nint(parameters(1)),new_bond%table,success)
+          new_bond%shared_table = success
+       else
+          write(tablefile,'(A6,I4.4,A4)') table_prefix, int(parameters(1)), table_suffix
+          call read_table(tablefile,new_bond%table,success)
+       end if
     case default
        nullify(new_bond%table)
        allocate(new_bond%table(0,0))
@@ -109,6 +109,8 @@ contains
   ! make sure the number of atoms specified in the last call
   ! matches the number of atoms in the core when a
   ! calculation is invoked.
+  ! When the neighbor lists are built, the atoms are
+  ! redistributed according to their positions.
   ! 
   ! Calls :func:`mpi_distribute`
   !
@@ -161,10 +163,29 @@ contains
     logical, intent(out) :: cpu_atoms(n_atoms)
     
     cpu_atoms(1:n_atoms) = is_my_atom(1:n_atoms) ! in MPI.f90
+    call core_restore_atom_order_of_logicals(cpu_atoms) ! in Core.f90
 
   end subroutine get_mpi_list_of_atoms
 
 
+  ! Returns a logical array containing true for every
+  ! atom that is in the halo of this cpu, i.e., atoms
+  ! that are not handled by this cpu but whose neighbor
+  ! lists are needed by it, and false for all other atoms.
+  !
+  ! *n_atoms number of atoms
+  ! *halo_atoms array of logical values showing which atoms are in the halo of this cpu
+  subroutine get_mpi_list_of_halo_atoms(n_atoms,halo_atoms)
+    implicit none
+    integer, intent(in) :: n_atoms
+    logical, intent(out) :: halo_atoms(n_atoms)
+    
+    halo_atoms(1:n_atoms) = is_halo_atom(1:n_atoms) ! in MPI.f90
+    call core_restore_atom_order_of_logicals(halo_atoms) ! in Core.f90
+
+  end subroutine get_mpi_list_of_halo_atoms
+
+
   ! Initializes the potentials.
   ! A routine is called to generate descriptors for
   ! potentials. These descriptors are needed by the
@@ -284,6 +305,28 @@ contains
   end subroutine update_atom_coordinates
 
 
+  ! Updates the positions of existing atoms, leaving the momenta as they are.
+  ! This method does not allocate memory and so the atoms
+  ! must already exist in the core.
+  !
+  ! Note that a C-ordered array of shape (n_atoms,3) in Python
+  ! occupies memory exactly as the array positions here, so the
+  ! transpose of such an array is passed in without copying.
+  ! 
+  ! Calls :func:`core_update_atom_positions`
+  !
+  ! *n_atoms number of atoms
+  ! *positions new coordinates for the atoms
+  subroutine update_atom_positions(n_atoms,positions)
+    implicit none
+    integer, intent(in) :: n_atoms
+    double precision, intent(in) :: positions(3,n_atoms)
+
+    call core_update_atom_positions(n_atoms,positions) ! in Core.f90
+
+  end subroutine update_atom_positions
+
+
   ! Updates the charges of existing atoms.
   ! This method does not allocate memory and so the atoms
   ! must already exist in the core.
@@ -462,6 +505,93 @@ contains
 
 
 
+  ! Evaluates a pair potential as a function of the distance of two atoms.
+  !
+  ! Calls :func:`core_evaluate_pair_potential`
+  !
+  ! *n_params number of parameters
+  ! *pot_name potential names
+  ! *parameters numeric parameters
+  ! *cutoff interaction hard cutoff
+  ! *smooth_cut interaction soft cutoff
+  ! *n_r number of distances
+  ! *distances the distances at which the potential is evaluated
+  ! *energies the energies :math:`V(r)`
+  ! *derivatives the derivatives :math:`dV/dr`
+  ! *success logical tag specifying if the potential could be evaluated
+  subroutine evaluate_pair_potential(n_params,pot_name,parameters,cutoff,smooth_cut,&
+       n_r,distances,energies,derivatives,success)
+    implicit none
+    integer, intent(in) :: n_params, n_r
+    character(len=*), intent(in) :: pot_name
+    double precision, intent(in) :: parameters(n_params)
+    double precision, intent(in) :: cutoff, smooth_cut, distances(n_r)
+    double precision, intent(out) :: energies(n_r), derivatives(n_r)
+    logical, intent(out) :: success
+
+    call core_evaluate_pair_potential(n_params,pot_name,parameters,cutoff,smooth_cut,&
+         n_r,distances,energies,derivatives,success) ! in Core.f90
+
+  end subroutine evaluate_pair_potential
+
+
+
+  ! Replaces the numeric parameters of a potential already created in the core.
+  !
+  ! Calls :func:`core_set_potential_parameters`
+  !
+  ! *index index of the potential, in the order of creation, starting from 0
+  ! *multiplier index of the multiplier of a product potential, 0 for the potential itself
+  ! *n_params number of parameters
+  ! *parameters the new numeric parameters
+  ! *success logical tag specifying if the update succeeded
+  subroutine set_potential_parameters(index,multiplier,n_params,parameters,success)
+    implicit none
+    integer, intent(in) :: index, multiplier, n_params
+    double precision, intent(in) :: parameters(n_params)
+    logical, intent(out) :: success
+
+    ! index +1 because fortran starts indexing from 1
+    call core_set_potential_parameters(index+1,multiplier,n_params,parameters,success) ! in Core.f90
+
+  end subroutine set_potential_parameters
+
+
+
+  ! Marks a parameter of a potential for differentiation.
+  !
+  ! Calls :func:`core_set_parameter_derivative`
+  !
+  ! *index index of the potential, in the order of creation, starting from 0
+  ! *multiplier index of the multiplier of a product potential, 0 for the potential itself
+  ! *param index of the parameter, starting from 0, or -1 to remove the mark
+  ! *success logical tag specifying if the marking succeeded
+  subroutine set_parameter_derivative(index,multiplier,param,success)
+    implicit none
+    integer, intent(in) :: index, multiplier, param
+    logical, intent(out) :: success
+
+    ! indices +1 because fortran starts indexing from 1
+    call core_set_parameter_derivative(index+1,multiplier,param+1,success) ! in Core.f90
+
+  end subroutine set_parameter_derivative
+
+
+  ! Switches the calculation of parameter derivatives on or off.
+  !
+  ! Calls :func:`core_set_parameter_derivative_mode`
+  !
+  ! *derivatives true for switching the derivatives on, false for switching them off
+  subroutine set_parameter_derivative_mode(derivatives)
+    implicit none
+    logical, intent(in) :: derivatives
+
+    call core_set_parameter_derivative_mode(derivatives) ! in Core.f90
+
+  end subroutine set_parameter_derivative_mode
+
+
+
   ! Creates a bond order factor in the core.
   ! The memory must have been allocated first using allocate_potentials.
   ! 
@@ -505,6 +635,64 @@ contains
 
 
 
+  ! Replaces the numeric parameters of a bond order factor already created in the core.
+  !
+  ! Calls :func:`core_set_bond_order_parameters`
+  !
+  ! *index index of the bond order factor, in the order of creation, starting from 0
+  ! *n_params number of parameters
+  ! *parameters the new numeric parameters
+  ! *success logical tag specifying if the update succeeded
+  subroutine set_bond_order_parameters(index,n_params,parameters,success)
+    implicit none
+    integer, intent(in) :: index, n_params
+    double precision, intent(in) :: parameters(n_params)
+    logical, intent(out) :: success
+
+    ! index +1 because fortran starts indexing from 1
+    call core_set_bond_order_parameters(index+1,n_params,parameters,success) ! in Core.f90
+
+  end subroutine set_bond_order_parameters
+
+
+
+  ! Stores a table of values in the core.
+  !
+  ! Tabulated potentials and bond order factors given the id -(index+1)
+  ! share the stored table instead of reading one from a file.
+  !
+  ! Calls :func:`core_store_table`
+  !
+  ! *index the index of the stored table, starting from 0
+  ! *n_values the number of tabulated values
+  ! *values the tabulated values and scaled derivatives, as rows
+  subroutine store_table(index,n_values,values)
+    implicit none
+    integer, intent(in) :: index, n_values
+    double precision, intent(in) :: values(2,n_values)
+
+    ! index +1 because fortran starts indexing from 1
+    call core_store_table(index+1,n_values,values) ! in Core.f90
+
+  end subroutine store_table
+
+
+  ! Releases a table stored in the core.
+  !
+  ! Calls :func:`core_remove_table`
+  !
+  ! *index the index of the stored table, starting from 0
+  subroutine remove_table(index)
+    implicit none
+    integer, intent(in) :: index
+
+    ! index +1 because fortran starts indexing from 1
+    call core_remove_table(index+1) ! in Core.f90
+
+  end subroutine remove_table
+
+
+
 
   ! Creates neighbor lists for a single atom 
   ! telling it which other atoms are in its
@@ -531,8 +719,10 @@ contains
     integer, intent(in) :: neighbors(n_nbs), offsets(3,n_nbs)
     integer, intent(in) :: atom_index
 
-    ! add +1 to neighbors because python indexing begins from 0 and fortran from 1
-    call core_create_neighbor_list(n_nbs,atom_index,neighbors+1,offsets) ! in Core.f90
+    ! add +1 to neighbors because python indexing begins from 0 and fortran from 1,
+    ! and find where the atoms are stored in the core
+    call core_create_neighbor_list(n_nbs,atom_storage_index(atom_index),&
+         atom_storage_index(neighbors+1),offsets) ! in Core.f90
 
   end subroutine create_neighbor_list
 
@@ -582,6 +772,7 @@ contains
     double precision, intent(out) :: bond_orders(n_atoms)
 
     call core_get_bond_order_factors(group_index,bond_orders) ! in Core.f90
+    call core_restore_atom_order_of_scalars(bond_orders) ! in Core.f90
 
   end subroutine calculate_bond_order_factors
 
@@ -609,7 +800,9 @@ contains
     double precision :: bo(n_atoms), virial(6)
  
     call core_get_bond_order_sums(group_index,bo) ! in Core.f90
-    call core_calculate_bond_order_gradients(group_index,atom_index,bo,gradients,virial) ! in Core.f90
+    call core_calculate_bond_order_gradients(group_index,atom_storage_index(atom_index),&
+         bo,gradients,virial) ! in Core.f90
+    call core_restore_atom_order_of_vectors(gradients) ! in Core.f90
 
   end subroutine calculate_bond_order_gradients
 
@@ -638,7 +831,9 @@ contains
     double precision :: bond_orders(n_atoms), virial(6)
  
     call core_get_bond_order_sums(group_index,bond_orders) ! in Core.f90
-    call core_calculate_bond_order_gradients_of_factor(group_index,atom_index,bond_orders,gradients,virial) ! in Core.f90
+    call core_calculate_bond_order_gradients_of_factor(group_index,atom_storage_index(atom_index),&
+         bond_orders,gradients,virial) ! in Core.f90
+    call core_restore_atom_order_of_vectors(gradients) ! in Core.f90
 
   end subroutine calculate_bond_order_gradients_of_factor
 
@@ -659,6 +854,10 @@ contains
 
 
   ! Returns forces acting on the particles and the stress tensor
+  !
+  ! The forces are written in the given array, so that
+  ! the caller owns the memory. A C-ordered array of shape (n_atoms,3)
+  ! in Python can be filled by passing in its transpose.
   ! 
   ! Calls :func:`core_calculate_forces`
   ! 
@@ -668,9 +867,11 @@ contains
   subroutine calculate_forces(n_atoms,forces,stress)
     implicit none
     integer, intent(in) :: n_atoms
-    double precision, intent(out) :: forces(3,n_atoms), stress(6)
+    double precision, intent(inout) :: forces(3,n_atoms)
+    double precision, intent(out) :: stress(6)
     
     call core_calculate_forces(forces,stress) ! in Core.f90
+    call core_restore_atom_order_of_vectors(forces) ! in Core.f90
 
   end subroutine calculate_forces
 
@@ -687,6 +888,7 @@ contains
     double precision, intent(out) :: enegs(n_atoms)
 
     call core_calculate_electronegativities(enegs) ! in Core.f90
+    call core_restore_atom_order_of_scalars(enegs) ! in Core.f90
 
   end subroutine calculate_electronegativities
 
@@ -855,6 +1057,24 @@ contains
 
   end subroutine number_of_parameters_of_potential
 
+  ! Tells if a parameter of a potential is discrete, i.e., used as an integer or an identifier.
+  ! 
+  ! Calls :func:`check_discrete_parameter_of_potential`
+  !
+  ! *pot_name name of the potential
+  ! *param index of the parameter, starting from 0
+  ! *discrete true if the parameter is discrete
+  subroutine discrete_parameter_of_potential(pot_name, param, discrete)
+    implicit none
+    character(len=*), intent(in) :: pot_name
+    integer, intent(in) :: param
+    logical, intent(out) :: discrete
+
+    ! param +1 because fortran starts indexing from 1
+    call check_discrete_parameter_of_potential(pot_name,param+1,discrete) ! in Potentials.f90
+
+  end subroutine discrete_parameter_of_potential
+
   ! Tells how many numeric parameters a bond order factor incorporates
   ! 
   ! Calls :func:`get_number_of_parameters_of_bond_order_factor`
@@ -1046,6 +1266,79 @@ contains
   end subroutine set_ewald_parameters
 
 
+  ! Sets the parameters for particle mesh Ewald summation in the core. 
+  !
+  ! *real_cut the real-space cutoff
+  ! *grid the number of grid points along each cell vector
+  ! *order the order of the B-splines
+  ! *sigma the split parameter
+  ! *epsilon electric constant  
+  ! *scaler scaling factors for the individual charges
+  subroutine set_pme_parameters(n_atoms, real_cut, grid, order, sigma, epsilon, scaler)
+    implicit none
+    double precision, intent(in) :: real_cut, sigma, epsilon, scaler(n_atoms)
+    integer, intent(in) :: grid(3), order, n_atoms
+
+    call core_set_pme_parameters(real_cut, grid, order, sigma, epsilon, scaler) ! in Core.f90
+
+  end subroutine set_pme_parameters
+
+
+  ! Sets the number of threads used in the evaluation of local interactions.
+  ! The core must be compiled with OpenMP for this to have an effect.
+  !
+  ! *n_threads the requested number of threads
+  subroutine set_number_of_threads(n_threads)
+    implicit none
+    integer, intent(in) :: n_threads
+
+    call core_set_number_of_threads(n_threads) ! in Core.f90
+
+  end subroutine set_number_of_threads
+
+
+  ! Returns the number of threads used in the evaluation of local interactions.
+  !
+  ! *n_threads the number of threads
+  subroutine get_number_of_threads(n_threads)
+    implicit none
+    integer, intent(out) :: n_threads
+
+    call core_get_number_of_threads(n_threads) ! in Core.f90
+
+  end subroutine get_number_of_threads
+
+
+  ! Switches the reordering of atoms in the core along a space-filling curve on or off.
+  ! The atoms are reordered when the neighbor lists are built. 
+  ! All data is still passed between Python and the core in the original order of the atoms.
+  !
+  ! Calls :func:`core_set_spatial_ordering`
+  !
+  ! *ordered true if the atoms should be ordered spatially
+  subroutine set_spatial_ordering(ordered)
+    implicit none
+    logical, intent(in) :: ordered
+
+    call core_set_spatial_ordering(ordered) ! in Core.f90
+
+  end subroutine set_spatial_ordering
+
+
+  ! Tells if the atoms are reordered in the core along a space-filling curve.
+  !
+  ! Calls :func:`core_get_spatial_ordering`
+  !
+  ! *ordered true if the atoms are ordered spatially
+  subroutine get_spatial_ordering(ordered)
+    implicit none
+    logical, intent(out) :: ordered
+
+    call core_get_spatial_ordering(ordered) ! in Core.f90
+
+  end subroutine get_spatial_ordering
+
+
   ! Debugging routine for Ewald
   subroutine get_ewald_energy(real_cut, k_cut, reciprocal_cut, sigma, epsilon, energy)
     implicit none
@@ -1059,25 +1352,295 @@ contains
 
 
   ! calculates and allocates neighbor lists
-  subroutine generate_neighbor_lists(n_atoms,cutoffs)
+  !
+  ! *n_atoms number of atoms
+  ! *cutoffs the cutoffs of the atoms, including the skin
+  ! *skin the skin width included in the cutoffs
+  subroutine generate_neighbor_lists(n_atoms,cutoffs,skin)
     implicit none
     integer, intent(in) :: n_atoms
-    double precision, intent(in) :: cutoffs(n_atoms)
+    double precision, intent(in) :: cutoffs(n_atoms), skin
     double precision :: max_cutoff
 
     max_cutoff = maxval(cutoffs)
     call core_create_space_partitioning(max_cutoff)
-    call core_build_neighbor_lists(cutoffs)
+    call core_build_neighbor_lists(cutoffs,skin)
 
   end subroutine generate_neighbor_lists
 
+
+  ! Divides the atoms in the core in several independent systems,
+  ! each in its own supercell.
+  !
+  ! Calls :func:`core_pack_systems`
+  !
+  ! *n_systems number of systems
+  ! *first_atoms indices of the first atoms of the systems
+  ! *vectors the vectors spanning the supercells of the systems, as in :func:`create_cell`
+  ! *inverses the inverse matrices of the vectors
+  ! *periodicities the periodicities of the systems
+  subroutine pack_systems(n_systems,first_atoms,vectors,inverses,periodicities)
+    implicit none
+    integer, intent(in) :: n_systems, first_atoms(n_systems)
+    double precision, intent(in) :: vectors(3,3,n_systems), inverses(3,3,n_systems)
+    logical, intent(in) :: periodicities(3,n_systems)
+
+    call core_pack_systems(n_systems,first_atoms,vectors,inverses,periodicities) ! in Core.f90
+
+  end subroutine pack_systems
+
+
+  ! Calculates and allocates neighbor lists for systems packed in the core
+  !
+  ! Calls :func:`core_build_packed_neighbor_lists`
+  !
+  ! *n_atoms number of atoms
+  ! *cutoffs the cutoffs of the atoms
+  subroutine generate_packed_neighbor_lists(n_atoms,cutoffs)
+    implicit none
+    integer, intent(in) :: n_atoms
+    double precision, intent(in) :: cutoffs(n_atoms)
+
+    call core_build_packed_neighbor_lists(cutoffs) ! in Core.f90
+
+  end subroutine generate_packed_neighbor_lists
+
+
+  ! Returns the potential energies of the systems packed in the core
+  ! from the latest energy evaluation.
+  !
+  ! Calls :func:`core_get_system_energies`
+  !
+  ! *n_systems number of systems
+  ! *energies the energies of the systems
+  subroutine get_system_energies(n_systems,energies)
+    implicit none
+    integer, intent(in) :: n_systems
+    double precision, intent(out) :: energies(n_systems)
+
+    call core_get_system_energies(energies) ! in Core.f90
+
+  end subroutine get_system_energies
+
+
+  ! Returns the potential parts of the stress of the systems packed in the core
+  ! from the latest force evaluation.
+  !
+  ! Calls :func:`core_get_system_stresses`
+  !
+  ! *n_systems number of systems
+  ! *stresses the stresses of the systems
+  subroutine get_system_stresses(n_systems,stresses)
+    implicit none
+    integer, intent(in) :: n_systems
+    double precision, intent(out) :: stresses(6,n_systems)
+
+    call core_get_system_stresses(stresses) ! in Core.f90
+
+  end subroutine get_system_stresses
+
+
+  ! Switches the collection of the energies and virials of individual atoms on or off
+  !
+  ! Calls :func:`core_set_atom_contributions`
+  !
+  ! *collect true if the contributions of the atoms are collected
+  subroutine set_atom_contributions(collect)
+    implicit none
+    logical, intent(in) :: collect
+
+    call core_set_atom_contributions(collect) ! in Core.f90
+
+  end subroutine set_atom_contributions
+
+
+  ! Returns the potential energies of the atoms from the latest energy evaluation
+  !
+  ! Calls :func:`core_get_atom_energies`
+  !
+  ! *n_atoms number of atoms
+  ! *energies the energies of the atoms
+  subroutine get_atom_energies(n_atoms,energies)
+    implicit none
+    integer, intent(in) :: n_atoms
+    double precision, intent(out) :: energies(n_atoms)
+
+    call core_get_atom_energies(energies) ! in Core.f90
+    call core_restore_atom_order_of_scalars(energies) ! in Core.f90
+
+  end subroutine get_atom_energies
+
+
+  ! Returns the virials of the atoms from the latest force evaluation
+  ! (in order :math:`xx,yy,zz,yz,xz,xy`)
+  !
+  ! Calls :func:`core_get_atom_virials`
+  !
+  ! *n_atoms number of atoms
+  ! *virials the virials of the atoms
+  subroutine get_atom_virials(n_atoms,virials)
+    implicit none
+    integer, intent(in) :: n_atoms
+    double precision, intent(out) :: virials(6,n_atoms)
+
+    call core_get_atom_virials(virials) ! in Core.f90
+    call core_restore_atom_order_of_vectors(virials) ! in Core.f90
+
+  end subroutine get_atom_virials
+
+
+  ! Runs a Metropolis Monte Carlo simulation with local energy updates.
+  ! The random number generator must have been initialized with :func:`start_rng`.
+  !
+  ! Calls :func:`core_monte_carlo`
+  !
+  ! *n_atoms number of atoms
+  ! *n_trials number of trial moves
+  ! *temperature the temperature in units of energy, :math:`k_B T`
+  ! *probabilities the relative probabilities of displacement, swap and charge transfer moves
+  ! *max_displacement the maximum displacement of an atom along each coordinate axis
+  ! *max_charge_transfer the maximum amount of charge transferred between two atoms
+  ! *cutoff the largest cutoff of the interactions
+  ! *skin the skin width of the neighbor lists
+  ! *positions the positions of the atoms at the end
+  ! *charges the charges of the atoms at the end
+  ! *species the index of the atom whose element, mass and charge each atom has at the end
+  ! *attempts the numbers of attempted displacement, swap and charge transfer moves
+  ! *accepted the numbers of accepted displacement, swap and charge transfer moves
+  ! *energy_change the total change in energy
+  subroutine run_monte_carlo(n_atoms,n_trials,temperature,probabilities,max_displacement,&
+       max_charge_transfer,cutoff,skin,positions,charges,species,attempts,accepted,energy_change)
+    implicit none
+    integer, intent(in) :: n_atoms, n_trials
+    double precision, intent(in) :: temperature, probabilities(3), max_displacement, &
+         max_charge_transfer, cutoff, skin
+    double precision, intent(out) :: positions(3,n_atoms), charges(n_atoms), energy_change
+    integer, intent(out) :: species(n_atoms), attempts(3), accepted(3)
+
+    call core_monte_carlo(n_trials,temperature,probabilities,max_displacement,max_charge_transfer,&
+         cutoff,skin,positions,charges,species,attempts,accepted,energy_change) ! in Core.f90
+
+  end subroutine run_monte_carlo
+
+
+  ! Runs molecular dynamics with the velocity Verlet algorithm, optionally 
+  ! with a thermostat. If the Langevin thermostat is used, the random number generator 
+  ! must have been initialized with :func:`start_rng`.
+  !
+  ! The forces are read from and written in the given array,
+  ! so that they need not be recalculated when the simulation is continued.
+  ! A C-ordered array of shape (n_atoms,3) in Python can be passed in as its transpose.
+  !
+  ! Calls :func:`core_molecular_dynamics`
+  !
+  ! *n_atoms number of atoms
+  ! *n_steps number of time steps
+  ! *timestep the length of the time step
+  ! *thermostat 0 for no thermostat, 1 for Langevin, 2 for Berendsen
+  ! *temperature the temperature of the thermostat in units of energy, :math:`k_B T`
+  ! *coupling the friction coefficient for Langevin or the time constant for Berendsen
+  ! *cutoffs the cutoffs of the neighbor lists of the atoms, including the skin
+  ! *skin the skin width of the neighbor lists
+  ! *fixed true for the atoms which do not move
+  ! *forces the forces acting on the atoms
+  ! *forces_ready true if the forces are given, false if they should be calculated first
+  ! *positions the positions of the atoms at the end
+  ! *momenta the momenta of the atoms at the end
+  ! *potential_energy the potential energy at the end
+  ! *kinetic_energy the kinetic energy at the end
+  ! *n_rebuilds the number of times the neighbor lists were rebuilt
+  subroutine run_molecular_dynamics(n_atoms,n_steps,timestep,thermostat,temperature,coupling,&
+       cutoffs,skin,fixed,forces,forces_ready,positions,momenta,potential_energy,&
+       kinetic_energy,n_rebuilds)
+    implicit none
+    integer, intent(in) :: n_atoms, n_steps, thermostat
+    double precision, intent(in) :: timestep, temperature, coupling, cutoffs(n_atoms), skin
+    logical, intent(in) :: fixed(n_atoms), forces_ready
+    double precision, intent(inout) :: forces(3,n_atoms), positions(3,n_atoms), momenta(3,n_atoms)
+    double precision, intent(out) :: potential_energy, kinetic_energy
+    integer, intent(out) :: n_rebuilds
+
+    call core_molecular_dynamics(n_steps,timestep,thermostat,temperature,coupling,&
+         cutoffs,skin,fixed,forces,forces_ready,positions,momenta,potential_energy,&
+         kinetic_energy,n_rebuilds) ! in Core.f90
+
+  end subroutine run_molecular_dynamics
+
+
+  ! Relaxes the structure with the FIRE algorithm, optionally including the cell.
+  !
+  ! The positions and the histories are written in the given arrays. 
+  ! The positions of an ASE Atoms object are stored in a C-ordered array of 
+  ! shape (n_atoms,3) in Python, which can be passed in as its transpose.
+  !
+  ! Calls :func:`core_fire_relaxation`
+  !
+  ! *n_atoms number of atoms
+  ! *n_history the length of the history arrays, at least max_steps + 1
+  ! *max_steps the maximum number of steps
+  ! *fmax the convergence criterion for the forces
+  ! *parameters the parameters of the algorithm, see :func:`core_fire_relaxation`
+  ! *n_min the number of steps with positive power before the time step is increased
+  ! *relax_cell true if also the cell is relaxed
+  ! *cell_mask the strain components which are relaxed
+  ! *cutoffs the cutoffs of the neighbor lists of the atoms, including the skin
+  ! *skin the skin width of the neighbor lists
+  ! *fixed true for the atoms which do not move
+  ! *record_energies true if the potential energy should be recorded on every step
+  ! *positions the positions of the atoms at the end
+  ! *vectors the vectors spanning the cell at the end
+  ! *force_history the largest force on each step
+  ! *energy_history the potential energy on each step, if recorded
+  ! *n_steps the number of steps taken
+  ! *converged true if the forces were converged
+  ! *n_rebuilds the number of times the neighbor lists were rebuilt
+  subroutine run_fire_relaxation(n_atoms,n_history,max_steps,fmax,parameters,n_min,relax_cell,cell_mask,&
+       cutoffs,skin,fixed,record_energies,positions,vectors,force_history,energy_history,&
+       n_steps,converged,n_rebuilds)
+    implicit none
+    integer, intent(in) :: n_atoms, n_history, max_steps, n_min
+    double precision, intent(in) :: fmax, parameters(7), cutoffs(n_atoms), skin
+    logical, intent(in) :: relax_cell, cell_mask(6), fixed(n_atoms), record_energies
+    double precision, intent(inout) :: positions(3,n_atoms), force_history(n_history), &
+         energy_history(n_history)
+    double precision, intent(out) :: vectors(3,3)
+    integer, intent(out) :: n_steps, n_rebuilds
+    logical, intent(out) :: converged
+
+    call core_fire_relaxation(max_steps,fmax,parameters,n_min,relax_cell,cell_mask,&
+         cutoffs,skin,fixed,record_energies,positions,vectors,force_history,energy_history,&
+         n_steps,converged,n_rebuilds) ! in Core.f90
+
+  end subroutine run_fire_relaxation
+
+  ! Returns statistics on the partitioning of the simulation cell in
+  ! subcells, done for the latest neighbor list build.
+  !
+  ! Calls :func:`core_get_subcell_statistics`
+  !
+  ! *splits the number of subcells along each cell vector
+  ! *n_subcells the total number of subcells, including the padding subcells
+  ! *n_occupied the number of subcells containing atoms
+  ! *max_atoms the largest number of atoms in a subcell
+  ! *sparse true if only the occupied subcells are stored in a hash table
+  ! *n_checks the number of atom pairs whose distance was checked in the latest neighbor list build
+  subroutine get_subcell_statistics(splits,n_subcells,n_occupied,max_atoms,sparse,n_checks)
+    implicit none
+    integer, intent(out) :: splits(3), n_occupied, max_atoms
+    integer(kind=8), intent(out) :: n_subcells, n_checks
+    logical, intent(out) :: sparse
+
+    call core_get_subcell_statistics(splits,n_subcells,n_occupied,max_atoms,sparse,n_checks) ! in Core.f90
+
+  end subroutine get_subcell_statistics
+
   ! Returns the number of neighbors for an atom
   subroutine get_number_of_neighbors_of_atom(atom_index,n_neighbors)
     implicit none
     integer, intent(in) :: atom_index
     integer, intent(out) :: n_neighbors
 
-    call core_get_number_of_neighbors(atom_index+1,n_neighbors)
+    call core_get_number_of_neighbors(atom_storage_index(atom_index+1),n_neighbors)
 
   end subroutine get_number_of_neighbors_of_atom
 
@@ -1088,12 +1651,68 @@ contains
     integer, intent(out) :: neighbors(n_neighbors), offsets(3,n_neighbors)
 
     ! shift the indices by one since python starts indexing at 0 while fortran does so at 1
-    call core_get_neighbor_list_of_atom(atom_index+1, n_neighbors, neighbors, offsets)
+    call core_get_neighbor_list_of_atom(atom_storage_index(atom_index+1), n_neighbors, neighbors, offsets)
+    call core_restore_atom_indices(neighbors) ! in Core.f90
     neighbors = neighbors-1
 
   end subroutine get_neighbor_list_of_atom
 
 
+  ! Returns the largest distance any atom has moved since
+  ! the neighbor lists were last built in the core.
+  !
+  ! Calls :func:`core_get_max_displacement`
+  !
+  ! *max_displacement the maximum displacement
+  subroutine get_max_displacement(max_displacement)
+    implicit none
+    double precision, intent(out) :: max_displacement
+
+    call core_get_max_displacement(max_displacement) ! in Core.f90
+
+  end subroutine get_max_displacement
+
+
+  ! Returns the total number of neighbors in the lists of all atoms
+  !
+  ! Calls :func:`core_get_total_number_of_neighbors`
+  !
+  ! *n_pairs the total number of neighbors
+  subroutine get_total_number_of_neighbors(n_pairs)
+    implicit none
+    integer, intent(out) :: n_pairs
+
+    call core_get_total_number_of_neighbors(n_pairs) ! in Core.f90
+
+  end subroutine get_total_number_of_neighbors
+
+
+  ! Returns the neighbor lists of all atoms in a single call.
+  ! The lists are packed in compressed sparse row format:
+  ! the neighbors of atom i (counting from 0) are found in
+  ! ``neighbors[pointers[i]:pointers[i+1]]`` and their offsets in
+  ! ``offsets[:,pointers[i]:pointers[i+1]]``.
+  ! This avoids calling the core separately for every atom.
+  !
+  ! Calls :func:`core_get_all_neighbor_lists`
+  !
+  ! *n_atoms number of atoms
+  ! *n_pairs the total number of neighbors, see :func:`get_total_number_of_neighbors`
+  ! *pointers the starting positions of the lists of each atom in the packed arrays
+  ! *neighbors the indices of the neighboring atoms
+  ! *offsets the offsets for periodic boundaries
+  subroutine get_all_neighbor_lists(n_atoms, n_pairs, pointers, neighbors, offsets)
+    implicit none
+    integer, intent(in) :: n_atoms, n_pairs
+    integer, intent(out) :: pointers(n_atoms+1), neighbors(n_pairs), offsets(3,n_pairs)
+
+    call core_get_all_neighbor_lists(n_atoms, n_pairs, pointers, neighbors, offsets) ! in Core.f90
+    ! shift the indices by one since python starts indexing at 0 while fortran does so at 1
+    neighbors = neighbors-1
+
+  end subroutine get_all_neighbor_lists
+
+
   ! Clears the temporary stored array of multiplier potentials
   subroutine clear_potential_multipliers()
     implicit none
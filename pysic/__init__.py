@@ -6,6 +6,8 @@ from pysic.utility.error import *
 from pysic.utility.atomeyeviewer import *
 from pysic.interactions.local import Potential, ProductPotential
 from pysic.interactions.bondorder import Coordinator, BondOrderParameters
+from pysic.interactions.tables import Table, load_table
+from pysic.interactions.tabulation import PairTabulation
 from pysic.interactions.coulomb import CoulombSummation
 from pysic.charges.relaxation import ChargeRelaxation
 from pysic.hybridcalculator import HybridCalculator 
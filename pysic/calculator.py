@@ -11,6 +11,8 @@ from pysic.interactions.local import Potential, ProductPotential
 from pysic.interactions.compound import CompoundPotential
 from pysic.interactions.bondorder import Coordinator, BondOrderParameters
 from pysic.interactions.coulomb import CoulombSummation
+from pysic.interactions.tables import Table, get_numbered_table
+from pysic.interactions.tabulation import PairTabulation
 from pysic.charges.relaxation import ChargeRelaxation
 
 import pysic.pysic_fortran as pf
@@ -19,6 +21,8 @@ import pysic.utility.f2py as pu
 import numpy as np
 import numpy.linalg as npla
 import ase.calculators.neighborlist as nbl
+from ase import Atoms
+from ase.data import chemical_symbols
 from itertools import permutations
 import copy
 import math
@@ -26,6 +30,44 @@ import math
 import pysic.utility.debug as d
 
 
+def element_codes(numbers):
+    """Returns the chemical symbols of atoms encoded as integers for the Fortran core.
+
+    Each element is only encoded once, using :meth:`~pysic.utility.f2py.str2ints`.
+    The codes are returned as an array of shape (2, n_atoms).
+
+    Parameters:
+
+    numbers: list of integers
+        the atomic numbers of the atoms
+    """
+    unique_numbers, element_indices = np.unique(numbers, return_inverse=True)
+    codes = np.array( [ pu.str2ints(chemical_symbols[number],2) for number in unique_numbers ] )
+    return codes[element_indices].T
+
+
+def fixed_atoms_mask(atoms):
+    """Returns a logical array marking the atoms fixed by `FixAtoms`_ constraints.
+
+    Only the atoms fixed in place can be handled by the simulation routines in 
+    the Fortran core, so an error is raised if the structure has other constraints.
+
+    .. _FixAtoms: https://wiki.fysik.dtu.dk/ase/ase/constraints.html
+
+    Parameters:
+
+    atoms: `ASE Atoms`_ object
+        the constrained structure
+    """
+    from ase.constraints import FixAtoms
+    fixed = np.zeros(len(atoms), dtype=bool)
+    for constraint in atoms.constraints:
+        if not isinstance(constraint, FixAtoms):
+            raise InvalidParametersError("Only FixAtoms constraints are supported, not "+constraint.__class__.__name__+".")
+        fixed[constraint.index] = True
+    return fixed
+
+
 class FastNeighborList(nbl.NeighborList):
     """ASE has a neighbor list class built in, `ASE NeighborList`_, but its implementation is
         currently inefficient, and building of the list is an :math:`O(n^2)`
@@ -46,7 +88,7 @@ class FastNeighborList(nbl.NeighborList):
         """
 
     neighbor_marginal = 0.5
-    """Default skin width for the neighbor list"""
+    """Default skin width for the neighbor list. The list is rebuilt once some atom has moved more than half this distance."""
 
     
     def __init__(self, cutoffs, skin=None):
@@ -59,6 +101,38 @@ class FastNeighborList(nbl.NeighborList):
                               self_interaction=False,
                               bothways=True)    
     
+    def update(self, atoms):
+        """Makes sure the list is up to date.
+        
+        Overrides the method in `ASE NeighborList`_.
+        Since the neighbors of each atom are searched within the cutoff of the
+        atom plus the skin width, the list remains valid as long as no atom has moved 
+        more than half the skin width since the list was built. The displacements are 
+        tracked in the Fortran core, so the atoms in the core must match the given 
+        structure, as in :meth:`~pysic.calculator.FastNeighborList.build`.
+        The list is rebuilt if the displacements exceed half the skin or if the supercell 
+        has changed. 
+        
+        Returns True if the list was rebuilt, False otherwise.
+        
+        Parameters:
+        
+        atoms: `ASE Atoms`_ object
+            the structure for which the neighbors are searched
+        """
+        if self.nupdates == 0:
+            self.build(atoms)
+            return True
+        
+        if ((self.pbc != atoms.get_pbc()).any() or
+            (self.cell != atoms.get_cell()).any() or
+            pf.pysic_interface.get_max_displacement() > 0.5*self.skin):
+            self.build(atoms)
+            return True
+        
+        return False
+    
+    
     def build(self,atoms):
         """Builds the neighbor list.
             
@@ -73,9 +147,11 @@ class FastNeighborList(nbl.NeighborList):
             structure. It does raise an error if the structures do not match, though.
             
             The neighbor search is done via the :meth:`generate_neighbor_lists` routine.
-            The routine builds the neighbor list in the core, after which the list is
-            fed back to the :class:`~pysic.calculator.FastNeighborList` object by looping over all
-            atoms and saving the lists of neighbors and offsets.
+            The routine builds the neighbor list in the core, after which the lists of
+            all atoms are fed back to the :class:`~pysic.calculator.FastNeighborList` object
+            in a single call. The lists are stored in compressed sparse row format:
+            the neighbors of atom ``i`` are ``neighbor_indices[neighbor_pointers[i]:neighbor_pointers[i+1]]``
+            and the corresponding offsets are the same rows of ``neighbor_offsets``.
 
             Parameters:
             
@@ -93,25 +169,65 @@ class FastNeighborList(nbl.NeighborList):
         self.cell = atoms.get_cell()
         
         
-        pf.pysic_interface.generate_neighbor_lists(self.cutoffs)
-                
-        self.neighbors = [np.empty(0, int) for a in range(len(atoms))]
-        self.displacements = [np.empty((0, 3), int) for a in range(len(atoms))]
-        
-        for i in range(len(atoms)):
-            n_nbs = pf.pysic_interface.get_number_of_neighbors_of_atom(i)
-            if n_nbs > 0:
-                (self.neighbors[i], self.displacements[i]) = pf.pysic_interface.get_neighbor_list_of_atom(i,n_nbs)
-                # the offsets are in Fortran array format, so they need to be transposed
-                self.displacements[i] = np.transpose(self.displacements[i])
+        pf.pysic_interface.generate_neighbor_lists(self.cutoffs,self.skin)
+
+        n_pairs = pf.pysic_interface.get_total_number_of_neighbors()
+        (self.neighbor_pointers,
+         self.neighbor_indices,
+         offsets) = pf.pysic_interface.get_all_neighbor_lists(len(atoms),n_pairs)
+        # the offsets are in Fortran array format, so they need to be transposed
+        # - the transpose of the Fortran-ordered array is a C-ordered view, not a copy
+        self.neighbor_offsets = offsets.transpose()
     
         self.nupdates += 1
+
+
+    def get_partitioning_statistics(self):
+        """Returns statistics on the spatial partitioning used in the latest build of the list.
+
+        For the neighbor search, the cell is divided in subcells at least as wide as
+        the largest cutoff (plus skin), and only atoms in adjacent subcells are compared.
+        The number of subcells is not limited, so the work per atom stays constant
+        as the system grows, which can be confirmed by checking that the number of 
+        distance checks per atom does not grow with the system size.
+        If there are many more subcells than atoms, e.g., for a cluster in a large vacuum,
+        only the occupied subcells are stored.
+
+        The statistics are returned in a dictionary with the keys
+
+        - 'splits': the number of subcells along each cell vector
+        - 'subcells': the total number of subcells (including padding subcells at non-periodic borders)
+        - 'occupied_subcells': the number of subcells containing atoms
+        - 'occupancy': the fraction of subcells containing atoms
+        - 'mean_atoms': the average number of atoms in the occupied subcells
+        - 'max_atoms': the largest number of atoms in a subcell
+        - 'sparse': True if only the occupied subcells are stored, in a hash table
+        - 'distance_checks': the number of atom pairs whose distance was checked
+        """
+        (splits, n_subcells, n_occupied, 
+         max_atoms, sparse, n_checks) = pf.pysic_interface.get_subcell_statistics()
+        n_atoms = pf.pysic_interface.get_number_of_atoms()
+        stats = {'splits': np.array(splits),
+                 'subcells': int(n_subcells),
+                 'occupied_subcells': int(n_occupied),
+                 'occupancy': 0.0,
+                 'mean_atoms': 0.0,
+                 'max_atoms': int(max_atoms),
+                 'sparse': bool(sparse),
+                 'distance_checks': int(n_checks)}
+        if n_subcells > 0:
+            stats['occupancy'] = float(n_occupied) / n_subcells
+        if n_occupied > 0:
+            stats['mean_atoms'] = float(n_atoms) / n_occupied
+        return stats
     
     
     def get_neighbors(self, index, atoms=None, sort=False):
         """Returns arrays containing the indices and offsets of the neighbors of the given atom.
         
         Overrides the method in `ASE NeighborList`_.
+        The returned arrays are views to the packed lists stored in the neighbor list
+        object, so they should not be modified.
         
         Parameters:
         
@@ -122,16 +238,119 @@ class FastNeighborList(nbl.NeighborList):
         sort: boolean
             if True, the list will be sorted according to distance
         """
-        n_nbs = pf.pysic_interface.get_number_of_neighbors_of_atom(index)
-        nbors = self.neighbors[index][0:n_nbs]
-        displ = self.displacements[index][0:n_nbs]
+        start = self.neighbor_pointers[index]
+        end = self.neighbor_pointers[index+1]
+        nbors = self.neighbor_indices[start:end]
+        displ = self.neighbor_offsets[start:end]
         
-        if sort and atoms is not None and n_nbs > 0:
+        if sort and atoms is not None and end > start:
             dists = self.get_neighbor_distances(index, atoms)
-            sorted_lists = np.array([np.append(o,np.array(n)) for (d,n,o) in sorted(zip(dists, nbors, displ), key=lambda dis: dis[0])])
-            return sorted_lists[:,3], sorted_lists[:,0:3]
+            order = np.argsort(dists, kind='mergesort')
+            return nbors[order], displ[order]
         
         return nbors, displ
+
+
+    def get_all_neighbors(self, atoms=None, sort=False):
+        """Returns the neighbor lists of all atoms as packed arrays.
+
+        The lists are given in compressed sparse row format as a tuple
+        ``(pointers, indices, offsets)``, where the neighbors of atom ``i`` are
+        ``indices[pointers[i]:pointers[i+1]]`` and their periodic boundary offsets are
+        ``offsets[pointers[i]:pointers[i+1]]``.
+        Unless sorting is requested, the arrays are the ones stored in the neighbor 
+        list object, not copies.
+
+        Parameters:
+        
+        atoms: ASE Atoms
+            the atoms object containing the absolute coordinates - needed only if sorting is necessary
+        sort: boolean
+            if True, the neighbors of each atom will be sorted according to distance
+        """
+        if sort and atoms is not None:
+            order = self.get_neighbor_order(atoms)
+            return self.neighbor_pointers, self.neighbor_indices[order], self.neighbor_offsets[order]
+        
+        return self.neighbor_pointers, self.neighbor_indices, self.neighbor_offsets
+
+
+    def get_neighbor_centers(self):
+        """Returns an array containing the index of the central atom for every
+        entry in the packed neighbor lists.
+        
+        That is, the array tells which atom each neighbor returned by
+        :meth:`~pysic.calculator.FastNeighborList.get_all_neighbors` is a neighbor of.
+        """
+        return np.repeat(np.arange(len(self.neighbor_pointers)-1),
+                         np.diff(self.neighbor_pointers))
+
+
+    def get_neighbor_order(self, atoms):
+        """Returns the permutation which sorts the neighbors of every atom according to distance.
+
+        The permutation applies to the packed arrays returned by 
+        :meth:`~pysic.calculator.FastNeighborList.get_all_neighbors`.
+        Since the neighbors are only reordered within the list of each atom,
+        the pointers to the beginning of each list are not affected.
+
+        Parameters:
+        
+        atoms: ASE Atoms
+            the atoms object containing the absolute coordinates
+        """
+        dists = self.get_all_neighbor_distances(atoms)
+        return np.lexsort((dists, self.get_neighbor_centers()))
+
+
+    def get_all_neighbor_separations(self, atoms, sort=False):
+        """Returns an array of atom-atom separation vectors for all atoms and their neighbors.
+        
+        The vectors are returned as a packed array, ordered as the neighbors
+        in :meth:`~pysic.calculator.FastNeighborList.get_all_neighbors`, and 
+        they are calculated for all pairs at once.
+        
+        Parameters:
+        
+        atoms: ASE Atoms
+            the atoms object containing the absolute coordinates
+        sort: boolean
+            if True, the neighbors of each atom will be sorted according to distance
+        """
+        positions = atoms.get_positions()
+        separations = positions[self.neighbor_indices] \
+            + np.dot(self.neighbor_offsets, atoms.get_cell()) \
+            - positions[self.get_neighbor_centers()]
+        
+        if sort:
+            dists = np.sqrt(np.sum(separations*separations, axis=1))
+            order = np.lexsort((dists, self.get_neighbor_centers()))
+            return separations[order]
+        
+        return separations
+
+
+    def get_all_neighbor_distances(self, atoms, sort=False):
+        """Returns an array of atom-atom distances for all atoms and their neighbors.
+        
+        The distances are returned as a packed array, ordered as the neighbors
+        in :meth:`~pysic.calculator.FastNeighborList.get_all_neighbors`, and 
+        they are calculated for all pairs at once.
+        
+        Parameters:
+        
+        atoms: ASE Atoms
+            the atoms object containing the absolute coordinates
+        sort: boolean
+            if True, the neighbors of each atom will be sorted according to distance
+        """
+        separations = self.get_all_neighbor_separations(atoms)
+        dists = np.sqrt(np.sum(separations*separations, axis=1))
+        
+        if sort:
+            return dists[np.lexsort((dists, self.get_neighbor_centers()))]
+        
+        return dists
     
     
     def get_neighbor_separations(self, index, atoms, sort=False):
@@ -148,19 +367,12 @@ class FastNeighborList(nbl.NeighborList):
         """
         
         indices, offsets = self.get_neighbors(index)
-        separations = np.array(len(indices)*[[0.0,0.0,0.0]])
-        dists = np.array(len(separations)*[0.0])
-        running = 0
-        for i, offset in zip(indices, offsets):
-            sep = atoms.positions[i] + np.dot(offset, atoms.get_cell()) - atoms.positions[index]
-            
-            separations[running] = sep
-            if sort:
-                dists[running] = math.sqrt(np.dot(sep,sep))                
-            running += 1
+        positions = atoms.get_positions()
+        separations = positions[indices] + np.dot(offsets, atoms.get_cell()) - positions[index]
 
         if sort:
-            return np.array([s for (d,s) in sorted(zip(dists, separations), key=lambda dis: dis[0])])
+            dists = np.sqrt(np.sum(separations*separations, axis=1))
+            return separations[np.argsort(dists, kind='mergesort')]
         
         return separations
 
@@ -177,14 +389,10 @@ class FastNeighborList(nbl.NeighborList):
             if True, the list will be sorted according to distance
         """
         separations = self.get_neighbor_separations(index, atoms)
-        dists = np.array(len(separations)*[0.0])
-        running = 0
-        for sep in separations:
-            dists[running] = math.sqrt(np.dot(sep,sep))
-            running += 1
+        dists = np.sqrt(np.sum(separations*separations, axis=1))
 
         if sort:
-            return np.array(sorted(dists))
+            return np.sort(dists)
             
         return dists
 
@@ -229,18 +437,41 @@ class Pysic:
     against :data:`~pysic.calculator.Pysic.core` instead of accessing the
     Fortran core itself.
     """
+
+    all_changes = ['positions', 'momenta', 'numbers', 'tags', 'masses', 'cell', 'pbc', 'initial_charges']
+    """The kinds of changes in the structure recognized by :meth:`~pysic.calculator.Pysic.set_atoms`."""
+
+    change_versions = {'positions': 'positions',
+                       'momenta': 'momenta',
+                       'numbers': 'numbers',
+                       'tags': 'numbers',
+                       'masses': 'numbers',
+                       'cell': 'cell',
+                       'pbc': 'cell',
+                       'initial_charges': 'charges'}
+    """The versions of data in :data:`~pysic.calculator.Pysic.core` affected by each kind of change."""
+
     def __init__(self,atoms=None,potentials=None,charge_relaxation=None,
                  coulomb=None,full_initialization=False):
         
         self.neighbor_lists_ready = False
         self.saved_cutoffs = None
         
+        self.versions = dict.fromkeys(CoreMirror.tracked_data)
+        self.fingerprints = {'potentials': None, 'coulomb': None}
         self.structure = None
         self.neighbor_list = None
         self.potentials = None
         self.charge_relaxation = None
         self.coulomb = None
+        self.pair_tabulation = None
         self.charges = None
+        self.n_threads = 1
+        self.spatial_ordering = False
+        self.core_potential_map = []
+        self.core_multipliers = []
+        self.n_core_potentials = 0
+        self.core_bond_order_map = []
 
         self.set_atoms(atoms)
         self.set_potentials(potentials)
@@ -249,12 +480,17 @@ class Pysic:
         
         self.forces = None
         self.stress = None
+        self.energies = None
+        self.virials = None
         self.energy = None
         self.electronegativities = None
 
         self.force_core_initialization = full_initialization
     
         self.extra_calculators = []
+        
+        self.neighbor_list_rebuilds = 0
+        self.neighbor_list_reuses = 0
 
 
     def __eq__(self,other):
@@ -328,7 +564,7 @@ class Pysic:
         atoms: `ASE Atoms`_ object
             ignored at the moment
         quantities: list of strings
-            list of keywords 'energy', 'forces', 'stress', 'electronegativities'
+            list of keywords 'energy', 'forces', 'stress', 'electronegativities', 'energies', 'stresses'
         """
         
         do_it = []
@@ -347,6 +583,10 @@ class Pysic:
                 do_it.append(self.electronegativities is None)
             elif mark == 'stress':
                 do_it.append(self.stress is None)
+            elif mark == 'energies':
+                do_it.append(self.energies is None)
+            elif mark == 'stresses':
+                do_it.append(self.virials is None)
             else:
                 do_it.append(False)
         
@@ -357,24 +597,23 @@ class Pysic:
         # It is of course possible that we have several Pysics
         # changing the core which would lead to unnecessary
         # recalculations.
-        if(not Pysic.core.atoms_ready(self.structure)):
-            #print "atoms"
-            do_it.append(True)
-        if(not Pysic.core.charges_ready(self.structure)):
-            #print "charges"
-            do_it.append(True)
-        if(not Pysic.core.cell_ready(self.structure)):
-            #print "cell"
-            do_it.append(True)
-        if(not Pysic.core.potentials_ready(self.potentials)):
-            #print "potentials"
-            do_it.append(True)
+        # The momenta do not affect the results, so they are not checked.
+        self.check_interactions()
+        for key in ['numbers', 'positions', 'charges', 'cell', 'potentials']:
+            if(not Pysic.core.is_current(key, self.versions[key])):
+                do_it.append(True)
             
         return any(do_it)
 
 
     def get_atoms(self):
-        """Returns the `ASE Atoms`_ object assigned to the calculator."""
+        """Returns the `ASE Atoms`_ object assigned to the calculator.
+
+        The object is the copy of the structure stored in the calculator.
+        It should not be edited directly, since the calculator only notices changes
+        given through :meth:`~pysic.calculator.Pysic.set_atoms` or
+        :meth:`~pysic.calculator.Pysic.update_charges`.
+        """
         return self.structure
 
 
@@ -415,6 +654,89 @@ class Pysic:
         average_eneg = enegs.sum()/len(enegs)
         return enegs - average_eneg
 
+
+    def start_charge_updates(self, atoms=None):
+        """Prepares the core for a sequence of charge-only updates.
+
+        The structure is assigned and the core is set up through
+        :meth:`~pysic.calculator.Pysic.set_core` as usual, so that the
+        geometry, the neighbor lists and the geometry-dependent parts of the
+        Coulomb summation are up to date in the core. After this, electronegativities
+        can be evaluated for varying charges with
+        :meth:`~pysic.calculator.Pysic.get_electronegativities_for_charges`
+        as long as the geometry is not changed.
+
+        Parameters:
+
+        atoms: `ASE atoms`_ object
+            the structure to be calculated
+        """
+        self.set_atoms(atoms)
+        self.set_core()
+
+
+    def get_electronegativities_for_charges(self, charges):
+        """Returns the electronegativities of atoms for the given charges in a fixed geometry.
+
+        This is a fast path for charge relaxation. Only the charge vector is
+        sent to the core and the electronegativities are calculated
+        directly, without comparing or copying the structure and without
+        checking whether the core is up to date. Therefore the core must have been
+        prepared with :meth:`~pysic.calculator.Pysic.start_charge_updates`
+        and neither the geometry nor the potentials may have been changed since.
+
+        The charges are also stored in the structure of the calculator and in
+        :data:`~pysic.calculator.Pysic.core` so that later calculations
+        see the core as up to date. Previously calculated energy, forces and
+        stress are discarded.
+
+        Parameters:
+
+        charges: numpy array of doubles
+            the atomic charges
+        """
+        charges = np.array(charges, dtype=float)
+
+        pf.pysic_interface.update_atom_charges(charges)
+        self.electronegativities = pf.pysic_interface.calculate_electronegativities(len(charges)).transpose()
+
+        self.forces = None
+        self.energy = None
+        self.stress = None
+        self.energies = None
+        self.virials = None
+        self.charges = charges
+
+        # the call for charges was changed between ASE 3.6 and 3.7
+        try:
+            self.structure.set_initial_charges(charges)
+        except:
+            self.structure.set_charges(charges)
+        self.versions['charges'] = CoreMirror.new_version()
+        Pysic.core.set_charges(charges, self.versions['charges'])
+
+        return np.copy(self.electronegativities)
+
+
+    def update_charges(self, charges):
+        """Sets the charges of the structure in the calculator and updates them in the core.
+
+        Unlike :meth:`~pysic.calculator.Pysic.set_atoms`, this does not copy or compare the structure.
+        Previously calculated energy, forces, stress and electronegativities are discarded.
+
+        Parameters:
+
+        charges: numpy array of doubles
+            the atomic charges
+        """
+        # the call for charges was changed between ASE 3.6 and 3.7
+        try:
+            self.structure.set_initial_charges(charges)
+        except:
+            self.structure.set_charges(charges)
+        self.versions['charges'] = CoreMirror.new_version()
+        self.update_core_charges()
+
     
     def get_forces(self, atoms=None, skip_charge_relaxation=False):
         """Returns the forces.
@@ -439,6 +761,86 @@ class Pysic:
         return np.copy(self.forces)
 
 
+    def update_positions(self, positions, momenta=None):
+        """Moves the atoms of the calculator to the given positions.
+
+        This is a fast path for driving the calculator with an external integrator.
+        Unlike :meth:`~pysic.calculator.Pysic.set_atoms`, the method does not
+        need an `ASE Atoms`_ object and neither compares nor copies the structure.
+        The positions are written in the structure of the calculator and 
+        sent to the core without transposing. If the positions are given as a 
+        C-ordered array of doubles of shape (n_atoms, 3), as numpy creates 
+        arrays by default, no temporary arrays are created either.
+        The neighbor lists are updated as needed.
+
+        Previously calculated energy, forces, stress and electronegativities are discarded.
+
+        Parameters:
+
+        positions: numpy array of doubles
+            the new positions of the atoms, shape (n_atoms, 3)
+        momenta: numpy array of doubles
+            the new momenta of the atoms, shape (n_atoms, 3), if they have changed
+        """
+        if self.structure is None:
+            raise MissingAtomsError("Updating positions before assigning a structure to the calculator.")
+        n_atoms = len(self.structure)
+        positions = np.asarray(positions, dtype=float)
+        if positions.shape != (n_atoms,3):
+            raise InvalidParametersError("The positions must be given as an array of shape ({n}, 3).".format(n=n_atoms))
+
+        self.structure.arrays['positions'][:] = positions
+        self.versions['positions'] = CoreMirror.new_version()
+        if momenta is not None:
+            self.structure.set_momenta(momenta)
+            self.versions['momenta'] = CoreMirror.new_version()
+
+        self.forces = None
+        self.energy = None
+        self.stress = None
+        self.energies = None
+        self.virials = None
+        self.electronegativities = None
+
+        self.set_core()
+
+
+    def compute_forces(self, out=None, skip_charge_relaxation=False):
+        """Returns the forces for the structure of the calculator, written in the given array.
+
+        This is the counterpart of :meth:`~pysic.calculator.Pysic.update_positions` for
+        reading the results. The core writes the forces directly in the given array,
+        which must be a C-ordered, writeable array of doubles of shape (n_atoms, 3). 
+        The same array can be reused on every step, so that no arrays are created.
+        If no array is given, a new one is created.
+
+        Since the array is owned by the caller, the forces are not stored in the calculator.
+        The stress tensor is, though.
+
+        Parameters:
+
+        out: numpy array of doubles
+            the array in which the forces are written
+        skip_charge_relaxation: logical
+            if True, the charge relaxation is not done
+        """
+        if self.structure is None:
+            raise MissingAtomsError("Calculating forces before assigning a structure to the calculator.")
+        n_atoms = len(self.structure)
+        if out is None:
+            out = np.empty([n_atoms,3])
+        elif not isinstance(out, np.ndarray) or out.dtype != np.float64 or \
+                out.shape != (n_atoms,3) or not out.flags['C_CONTIGUOUS'] or not out.flags['WRITEABLE']:
+            raise InvalidParametersError("The forces can only be written in a writeable C-ordered array of doubles of shape ({n}, 3).".format(n=n_atoms))
+
+        if self.forces is None or self.calculation_required(None,'forces'):
+            self.calculate_forces(skip_charge_relaxation=skip_charge_relaxation, out=out)
+        else:
+            out[:] = self.forces
+
+        return out
+
+
     def get_potential_energy(self, atoms=None, force_consistent=False,
                              skip_charge_relaxation=False):
         """Returns the potential energy.
@@ -533,8 +935,890 @@ class Pysic:
         # ASE NPT simulator wants the pressure with an inversed sign
         return np.copy(-( kinetic_stress + self.stress ) / self.structure.get_volume())
 
+
+    def get_potential_energies(self, atoms=None, skip_charge_relaxation=False):
+        """Returns the potential energies of the atoms.
+
+        The energy of every interacting atom, pair, triplet and quadruplet is divided
+        evenly between the atoms involved, so that the energies of the atoms add up to 
+        the potential energy. If Ewald summation is used, the reciprocal space energy
+        is divided as :math:`E_i = -\\frac{1}{2} q_i \\chi_i`, where :math:`\\chi_i` is the
+        reciprocal space part of the electronegativity of atom :math:`i`.
+
+        The energies are collected during the evaluation of the potential energy, 
+        which is therefore also known afterwards.
+
+        If the atoms parameter is given, it will be used for updating the
+        structure assigned to the calculator prior to calculating the energies.
+        Otherwise the structure already associated with the calculator is used.
+
+        Parameters:
+
+        atoms: `ASE atoms`_ object
+            the structure for which the energies are determined
+        skip_charge_relaxation: logical
+            if True, the charge relaxation is not done
+        """
+        self.set_atoms(atoms)
+        if self.calculation_required(atoms,'energies'):
+            self.calculate_energy(skip_charge_relaxation=skip_charge_relaxation,
+                                  atom_contributions=True)
+
+        return np.copy(self.energies)
+
+
+    def get_stresses(self, atoms=None, skip_charge_relaxation=False):
+        """Returns the stress tensors of the atoms, one row for each atom in the format of 
+        :meth:`~pysic.calculator.Pysic.get_stress`.
+
+        The virial of every interacting atom, pair, triplet and quadruplet is divided
+        evenly between the atoms involved, and the kinetic term of each atom is added to
+        its own virial. Like the total stress, the stresses of the atoms are normalized
+        by the volume of the cell, so that they add up to the stress given by 
+        :meth:`~pysic.calculator.Pysic.get_stress`. If Ewald summation is used,
+        the reciprocal space virial is divided evenly between all the atoms.
+
+        The virials are collected during the evaluation of the forces,
+        which are therefore also known afterwards.
+
+        Parameters:
+
+        atoms: `ASE atoms`_ object
+            the structure for which the stresses are determined
+        skip_charge_relaxation: logical
+            if True, the charge relaxation is not done
+        """
+        self.set_atoms(atoms)
+        if self.calculation_required(atoms,'stresses'):
+            self.calculate_stress(skip_charge_relaxation=skip_charge_relaxation,
+                                  atom_contributions=True)
+
+        momenta = self.structure.get_momenta()
+        velocities = momenta / self.structure.get_masses()[:,np.newaxis]
+
+        # s_xx, s_yy, s_zz, s_yz, s_xz, s_xy
+        kinetic_stresses = np.array( [ momenta[:,0]*velocities[:,0],
+                                       momenta[:,1]*velocities[:,1],
+                                       momenta[:,2]*velocities[:,2],
+                                       momenta[:,1]*velocities[:,2],
+                                       momenta[:,0]*velocities[:,2],
+                                       momenta[:,0]*velocities[:,1] ] ).T
+
+        return -( kinetic_stresses + self.virials ) / self.structure.get_volume()
+
     
-    def set_atoms(self, atoms=None):
+    def evaluate_batch(self, structures):
+        """Calculates the energies, forces and stresses of several independent structures at once.
+
+        Evaluating many small structures one at a time is slow, since the Fortran
+        core is initialized from scratch whenever the number of atoms changes.
+        Instead, this method packs all the structures in the core together, each
+        in its own cell with its own periodic boundaries, so that atoms of different
+        structures never interact. The core is initialized once for the whole batch 
+        and all the structures are evaluated in a single pass.
+
+        The neighbor lists are built by checking all pairs of atoms within each structure,
+        so the method is meant for batches of small structures. These may also be
+        periodic structures smaller than the cutoffs.
+
+        Coulomb summation and additional calculators are not supported and
+        the charges are not relaxed. Potentials targeting atoms by their indices
+        see the indices of the atoms in the packed batch, the atoms of the
+        structures numbered consecutively in the order of the structures.
+
+        The structure assigned to the calculator and the results calculated for it
+        are not affected, but the core will be initialized again when it is next used.
+
+        Three arrays are returned: the potential energies of the structures,
+        the forces on all the atoms concatenated in the order of the structures
+        in an array of shape (n_atoms, 3), and the stresses of the structures
+        in an array of shape (n_structures, 6) in the format of 
+        :meth:`~pysic.calculator.Pysic.get_stress`.
+
+        Parameters:
+
+        structures: list of `ASE Atoms`_ objects
+            the structures to be evaluated
+        """
+        n_structures = len(structures)
+        if n_structures == 0:
+            return np.zeros(0), np.zeros([0,3]), np.zeros([0,6])
+
+        batch = self.pack_batch(structures)
+        return self.calculate_batch(batch)
+
+
+    def evaluate_parameter_sweep(self, structures, potentials, parameter_sets):
+        """Calculates the energies, forces and stresses of structures for many sets of potential parameters.
+
+        When fitting potentials, the same structures are evaluated over and over
+        with different parameter values. Normally, any change in the parameters
+        makes the calculator rebuild all the potentials in the core and reassign
+        them to the atoms. Here, the structures are packed in the core once as in
+        :meth:`~pysic.calculator.Pysic.evaluate_batch` and for each set of parameters
+        only the parameter values of the given potentials are replaced in the core. 
+        The neighbor lists and the lists of potentials affecting each atom are not touched, 
+        so the potentials may not change their targets or cutoffs.
+
+        The given :class:`~pysic.interactions.local.Potential` objects must be potentials of the calculator or 
+        components of its :class:`~pysic.interactions.local.ProductPotential` potentials. Note that products
+        store copies of their components, so these must be obtained from
+        :meth:`~pysic.interactions.local.ProductPotential.get_potentials`.
+        The objects themselves are not modified.
+        The limitations of :meth:`~pysic.calculator.Pysic.evaluate_batch` apply.
+
+        Three arrays are returned: the potential energies of the structures 
+        in an array of shape (n_sets, n_structures),
+        the forces on all the atoms concatenated in the order of the structures
+        in an array of shape (n_sets, n_atoms, 3), and the stresses of the structures
+        in an array of shape (n_sets, n_structures, 6) in the format of 
+        :meth:`~pysic.calculator.Pysic.get_stress`.
+
+        Parameters:
+
+        structures: list of `ASE Atoms`_ objects
+            the structures to be evaluated
+        potentials: list of :class:`~pysic.interactions.local.Potential` objects
+            the potentials whose parameters are varied
+        parameter_sets: array of doubles
+            an array of shape (n_sets, n_parameters), each row containing the parameters of all
+            the given potentials, in the order of the potentials and in the order of
+            :meth:`~pysic.interactions.local.Potential.get_parameter_values` for each potential
+        """
+        parameter_sets = np.atleast_2d(np.array(parameter_sets, dtype=float))
+        n_params = [ pot.get_number_of_parameters() for pot in potentials ]
+        if parameter_sets.shape[1] != sum(n_params):
+            raise InvalidParametersError("The potentials take {n} parameters in total, not {m}.".
+                                         format(n=sum(n_params), m=parameter_sets.shape[1]))
+
+        n_sets = len(parameter_sets)
+        n_structures = len(structures)
+        n_atoms = sum( [ len(structure) for structure in structures ] )
+        energies = np.zeros([n_sets, n_structures])
+        forces = np.zeros([n_sets, n_atoms, 3])
+        stresses = np.zeros([n_sets, n_structures, 6])
+        if n_structures == 0 or n_sets == 0:
+            return energies, forces, stresses
+
+        batch = self.pack_batch(structures)
+        targets = self.get_core_potential_targets(potentials)
+        
+        first_params = np.concatenate( [[0], np.cumsum(n_params)] )
+        for i in range(n_sets):
+            for j in range(len(potentials)):
+                self.set_core_potential_parameters(potentials[j], targets[j],
+                                                   parameter_sets[i, first_params[j]:first_params[j+1]])
+            energies[i], forces[i], stresses[i] = self.calculate_batch(batch, forces[i])
+
+        # the core no longer holds the parameters of the potentials
+        Pysic.core.set_potentials(None)
+
+        return energies, forces, stresses
+
+
+    def pack_batch(self, structures):
+        """Packs several independent structures in the core.
+
+        This is the initialization step of :meth:`~pysic.calculator.Pysic.evaluate_batch`.
+        The structures are packed in the core along with the potentials, neighbor lists
+        and potential lists. The returned data is needed by 
+        :meth:`~pysic.calculator.Pysic.calculate_batch`. It is also recorded as
+        ``batch`` in the :class:`~pysic.core.CoreMirror` as long as the structures stay in the core.
+
+        Parameters:
+
+        structures: list of `ASE Atoms`_ objects
+            the structures to be packed
+        """
+        if self.coulomb is not None:
+            raise InvalidParametersError("Coulomb summation is not supported in batch evaluation.")
+        if self.extra_calculators is not None and len(self.extra_calculators) > 0:
+            raise InvalidParametersError("Additional calculators are not supported in batch evaluation.")
+
+        counts = np.array( [ len(structure) for structure in structures ] )
+        first_atoms = np.concatenate( [[0], np.cumsum(counts)[:-1]] )
+
+        charges = []
+        for structure in structures:
+            # the call for charges was changed between ASE 3.6 and 3.7
+            try:
+                charges.append( structure.get_initial_charges() )
+            except:
+                charges.append( structure.get_charges() )
+        charges = np.concatenate(charges)
+
+        masses = np.concatenate( [ structure.get_masses() for structure in structures ] )
+        momenta = np.concatenate( [ structure.get_momenta() for structure in structures ] )
+        batch = Atoms( numbers = np.concatenate( [ structure.get_atomic_numbers() for structure in structures ] ),
+                       positions = np.concatenate( [ structure.get_positions() for structure in structures ] ),
+                       tags = np.concatenate( [ structure.get_tags() for structure in structures ] ) )
+
+        cells = np.array( [ structure.get_cell() for structure in structures ] )
+        vectors = cells.transpose(2,1,0)
+        inverses = np.array( [ np.linalg.inv(cell) for cell in cells ] ).transpose(2,1,0)
+        periodicities = np.array( [ structure.get_pbc() for structure in structures ] ).T
+
+        # The core no longer holds the structure of any calculator.
+        Pysic.core.set_atoms(None)
+        Pysic.core.set_neighbor_lists(None)
+        Pysic.core.set_coulomb(None)
+        self.neighbor_lists_waiting = False
+
+        pf.pysic_interface.create_atoms(masses,
+                                        charges,
+                                        batch.arrays['positions'].T,
+                                        momenta.T,
+                                        batch.get_tags(),
+                                        element_codes(batch.get_atomic_numbers()))
+        n_atoms = len(batch)
+        pf.pysic_interface.distribute_mpi(n_atoms)
+        Pysic.core.mpi_ready = True
+        pf.pysic_interface.pack_systems(first_atoms+1, vectors, inverses, periodicities)
+
+        self.update_core_potentials()
+        pf.pysic_interface.generate_packed_neighbor_lists(np.array(self.get_individual_cutoffs(1.0,batch)))
+        pf.pysic_interface.create_potential_list()
+        pf.pysic_interface.create_bond_order_factor_list()
+
+        batch = (counts, cells, masses, momenta)
+        Pysic.core.batch = batch
+        return batch
+
+
+    def calculate_batch(self, batch, forces=None, include_kinetic=True):
+        """Calculates the energies, forces and stresses of structures packed in the core.
+
+        This is the calculation step of :meth:`~pysic.calculator.Pysic.evaluate_batch`
+        and the results are as returned by that method.
+
+        Parameters:
+
+        batch: tuple
+            the data returned by :meth:`~pysic.calculator.Pysic.pack_batch`
+        forces: array of doubles
+            if given, the forces are written in this C-ordered array of shape (n_atoms, 3)
+        include_kinetic: logical
+            if False, the kinetic contribution of the atoms is left out of the stresses
+        """
+        counts, cells, masses, momenta = batch
+        n_structures = len(counts)
+        n_atoms = len(masses)
+
+        pf.pysic_interface.calculate_energy()
+        energies = pf.pysic_interface.get_system_energies(n_structures)
+        if forces is None:
+            forces = np.empty([n_atoms,3])
+        pf.pysic_interface.calculate_forces(forces.T)
+        stresses = pf.pysic_interface.get_system_stresses(n_structures).T
+
+        # the kinetic contribution and the normalization as in get_stress
+        if include_kinetic:
+            velocities = momenta / masses[:,np.newaxis]
+            kinetic = np.array( [ momenta[:,0]*velocities[:,0],
+                                  momenta[:,1]*velocities[:,1],
+                                  momenta[:,2]*velocities[:,2],
+                                  momenta[:,1]*velocities[:,2],
+                                  momenta[:,0]*velocities[:,2],
+                                  momenta[:,0]*velocities[:,1] ] ).T
+            atom_structures = np.repeat(np.arange(n_structures), counts)
+            kinetic_stresses = np.array( [ np.bincount(atom_structures, kinetic[:,i], n_structures) for i in range(6) ] ).T
+            stresses = stresses + kinetic_stresses
+        volumes = np.abs( np.linalg.det(cells) )
+        stresses = -stresses / volumes[:,np.newaxis]
+
+        return energies, forces, stresses
+
+
+    def get_parameter_gradients(self, structures, potentials, bond_order_parameters=None, free=None):
+        """Calculates the derivatives of the energies, forces and stresses of structures with respect to potential parameters.
+
+        The structures are packed in the core as in :meth:`~pysic.calculator.Pysic.evaluate_batch`
+        and the derivatives are calculated by :meth:`~pysic.calculator.Pysic.calculate_parameter_gradients`,
+        where the arguments and the returned arrays are explained.
+
+        Parameters:
+
+        structures: list of `ASE Atoms`_ objects
+            the structures to be evaluated
+        potentials: list of :class:`~pysic.interactions.local.Potential` objects
+            the potentials whose parameters are differentiated
+        bond_order_parameters: list of :class:`~pysic.interactions.bondorder.BondOrderParameters` objects
+            the bond order factors whose parameters are differentiated
+        free: list of logicals
+            if given, only the parameters marked True are differentiated
+        """
+        batch = self.pack_batch(structures)
+        try:
+            gradients = self.calculate_parameter_gradients(batch, potentials, bond_order_parameters, free)
+        finally:
+            # the core no longer holds the parameters of the potentials
+            Pysic.core.set_potentials(None)
+        return gradients
+
+
+    def calculate_parameter_gradients(self, batch, potentials, bond_order_parameters=None, free=None, shift=0.0001):
+        """Calculates the derivatives of the energies, forces and stresses of structures packed in the core.
+
+        The structures must have been packed with :meth:`~pysic.calculator.Pysic.pack_batch`.
+        The derivatives with respect to the parameters of potentials are calculated in the core
+        in a single pass over the atoms per parameter: the energy and force loops are run
+        with the marked parameter in place of the potential itself, so that bond order factors
+        and products of potentials are accounted for as in the normal evaluation.
+        Most potentials are differentiated analytically. For the others, the core 
+        differentiates numerically the contributions of the potential alone, 
+        so the neighbor lists and bond order factors are still evaluated only once.
+
+        The parameters of bond order factors enter the energy nonlinearly through the whole
+        bond order sum, so their derivatives are calculated as central differences 
+        by changing the parameters in the core, using the given relative shift.
+
+        Discrete parameters, listed by :meth:`~pysic.core.discrete_parameters`, are not differentiated
+        and their derivatives are left zero. These are the exponents n and m of 'bond_bend',
+        the exponent n of 'charge_self', the exponents n1 and n2 of 'charge_pair' and
+        the ids of 'tabulated' potentials and 'table_bond' and 'table_scale' bond order factors.
+        Only the parameters marked free are differentiated and included in the results,
+        and marking a discrete parameter free raises an error.
+
+        The given objects must be used by the calculator as in 
+        :meth:`~pysic.calculator.Pysic.evaluate_parameter_sweep`.
+        The parameters are numbered in the order of the potentials and 
+        :meth:`~pysic.interactions.local.Potential.get_parameter_values` for each potential,
+        followed by the bond order factors and
+        :meth:`~pysic.interactions.bondorder.BondOrderParameters.get_parameters_as_list` for each factor.
+
+        Three arrays are returned: the derivatives of the potential energies of the structures 
+        in an array of shape (n_free, n_structures),
+        the derivatives of the forces on all the atoms in an array of shape (n_free, n_atoms, 3), 
+        and the derivatives of the stresses of the structures
+        in an array of shape (n_free, n_structures, 6), where n_free is the number of free parameters.
+
+        Parameters:
+
+        batch: tuple
+            the data returned by :meth:`~pysic.calculator.Pysic.pack_batch`
+        potentials: list of :class:`~pysic.interactions.local.Potential` objects
+            the potentials whose parameters are differentiated
+        bond_order_parameters: list of :class:`~pysic.interactions.bondorder.BondOrderParameters` objects
+            the bond order factors whose parameters are differentiated
+        free: list of logicals
+            True for the parameters to be differentiated, by default all parameters are
+        shift: double
+            the relative shift of the bond order parameters in numeric differentiation
+        """
+        if bond_order_parameters is None:
+            bond_order_parameters = []
+        counts, cells, masses, momenta = batch
+        n_structures = len(counts)
+        n_atoms = len(masses)
+
+        targets = self.get_core_potential_targets(potentials)
+        bond_targets = self.get_core_bond_order_targets(bond_order_parameters)
+
+        discrete = self.get_discrete_parameters(potentials, bond_order_parameters)
+        n_params = len(discrete)
+        if free is None:
+            free = np.ones(n_params, dtype=bool)
+        else:
+            free = np.array(free, dtype=bool)
+            if len(free) != n_params:
+                raise InvalidParametersError("The potentials have {n} parameters, not {m}.".
+                                             format(n=n_params, m=len(free)))
+            if np.any(free & discrete):
+                raise InvalidParametersError("Discrete parameters cannot be differentiated: {p}".
+                                             format(p=list(np.nonzero(free & discrete)[0])))
+        n_free = np.count_nonzero(free)
+        d_energies = np.zeros([n_free, n_structures])
+        d_forces = np.zeros([n_free, n_atoms, 3])
+        d_stresses = np.zeros([n_free, n_structures, 6])
+
+        # all parameters are counted in k, the returned rows in row
+        k = 0
+        row = 0
+        pf.pysic_interface.set_parameter_derivative_mode(True)
+        try:
+            for pot, pot_targets in zip(potentials, targets):
+                for param in range(pot.get_number_of_parameters()):
+                    if not free[k]:
+                        k += 1
+                        continue
+                    if discrete[k]:
+                        # the derivative of a discrete parameter is left zero
+                        k += 1
+                        row += 1
+                        continue
+                    for index, multiplier in pot_targets:
+                        if not pf.pysic_interface.set_parameter_derivative(index, multiplier, param):
+                            raise InvalidParametersError("Failed to mark a parameter in the core: "+str(pot))
+                    d_energies[row], d_forces[row], d_stresses[row] = \
+                        self.calculate_batch(batch, d_forces[row], include_kinetic=False)
+                    for index, multiplier in pot_targets:
+                        pf.pysic_interface.set_parameter_derivative(index, multiplier, -1)
+                    k += 1
+                    row += 1
+        finally:
+            pf.pysic_interface.set_parameter_derivative_mode(False)
+
+        lower_forces = np.empty([n_atoms, 3])
+        for bond, bond_indices in zip(bond_order_parameters, bond_targets):
+            values = self.get_core_parameters(bond)
+            try:
+                for param in range(len(values)):
+                    if not free[k]:
+                        k += 1
+                        continue
+                    if discrete[k]:
+                        k += 1
+                        row += 1
+                        continue
+                    step = shift * max(abs(values[param]), 1.0)
+                    shifted = values.copy()
+                    shifted[param] = values[param] - step
+                    self.set_core_bond_order_parameters(bond_indices, shifted)
+                    lower = self.calculate_batch(batch, lower_forces, include_kinetic=False)
+                    shifted[param] = values[param] + step
+                    self.set_core_bond_order_parameters(bond_indices, shifted)
+                    upper = self.calculate_batch(batch, d_forces[row], include_kinetic=False)
+                    d_energies[row] = (upper[0] - lower[0]) / (2.0*step)
+                    d_forces[row] -= lower_forces
+                    d_forces[row] /= 2.0*step
+                    d_stresses[row] = (upper[2] - lower[2]) / (2.0*step)
+                    k += 1
+                    row += 1
+            finally:
+                self.set_core_bond_order_parameters(bond_indices, values)
+
+        return d_energies, d_forces, d_stresses
+
+
+    def get_core_potential_targets(self, potentials):
+        """Lists the core potentials created from each of the given potentials.
+
+        For each potential, a list of [index, multiplier] pairs is returned
+        as recorded in ``core_potential_map``. These are needed by
+        :meth:`~pysic.calculator.Pysic.set_core_potential_parameters`.
+
+        Parameters:
+
+        potentials: list of :class:`~pysic.interactions.local.Potential` objects
+            potentials used by the calculator
+        """
+        targets = []
+        for pot in potentials:
+            pot_targets = [ [index, multiplier] for (core_pot, index, multiplier) in self.core_potential_map
+                            if core_pot is pot ]
+            if len(pot_targets) == 0:
+                raise InvalidParametersError("The potential is not used by the calculator: \n\n"+str(pot))
+            targets.append(pot_targets)
+        return targets
+
+
+    def get_core_bond_order_targets(self, bond_order_parameters):
+        """Lists the core bond order factors created from each of the given bond order factors.
+
+        For each factor, a list of indices is returned as recorded in ``core_bond_order_map``.
+        These are needed by :meth:`~pysic.calculator.Pysic.set_core_bond_order_parameters`.
+
+        Parameters:
+
+        bond_order_parameters: list of :class:`~pysic.interactions.bondorder.BondOrderParameters` objects
+            bond order factors used by the calculator
+        """
+        targets = []
+        for bond in bond_order_parameters:
+            bond_indices = [ index for (core_bond, index) in self.core_bond_order_map if core_bond is bond ]
+            if len(bond_indices) == 0:
+                raise InvalidParametersError("The bond order factor is not used by the calculator: \n\n"+str(bond))
+            targets.append(bond_indices)
+        return targets
+
+
+    def set_core_potential_parameters(self, potential, targets, values):
+        """Replaces the parameters of a potential in the core.
+
+        The potential object itself is not modified.
+
+        Parameters:
+
+        potential: :class:`~pysic.interactions.local.Potential` object
+            the potential
+        targets: list of [integer, double] pairs
+            the core potentials of the potential as given by
+            :meth:`~pysic.calculator.Pysic.get_core_potential_targets`
+        values: list of doubles
+            the new parameters as in :meth:`~pysic.interactions.local.Potential.get_parameter_values`
+        """
+        values = self.get_core_parameters(potential, values)
+        for index, multiplier in targets:
+            if not pf.pysic_interface.set_potential_parameters(index, multiplier, values):
+                raise InvalidParametersError("Failed to update the parameters in the core: "+str(potential))
+
+
+    def get_discrete_parameters(self, potentials, bond_order_parameters=None):
+        """Tells which parameters of the given potentials and bond order factors are discrete.
+
+        An array of logicals is returned, with True for the parameters listed by
+        :meth:`~pysic.core.discrete_parameters`. The parameters are numbered as in
+        :meth:`~pysic.calculator.Pysic.calculate_parameter_gradients`.
+
+        Parameters:
+
+        potentials: list of :class:`~pysic.interactions.local.Potential` objects
+            the potentials
+        bond_order_parameters: list of :class:`~pysic.interactions.bondorder.BondOrderParameters` objects
+            the bond order factors
+        """
+        if bond_order_parameters is None:
+            bond_order_parameters = []
+        discrete = []
+        for pot in potentials:
+            discrete += discrete_parameters(pot.get_potential_type())
+        for bond in bond_order_parameters:
+            for target_discrete in discrete_parameters(bond.get_bond_order_type()):
+                discrete += target_discrete
+        return np.array(discrete, dtype=bool)
+
+
+    def set_core_bond_order_parameters(self, bond_indices, values):
+        """Replaces the parameters of bond order factors in the core.
+
+        Parameters:
+
+        bond_indices: list of integers
+            the indices of the factors in the core, as recorded in ``core_bond_order_map``
+        values: array of doubles
+            the new parameters as a single list as in
+            :meth:`~pysic.interactions.bondorder.BondOrderParameters.get_parameters_as_list`
+        """
+        for index in bond_indices:
+            if not pf.pysic_interface.set_bond_order_parameters(index, values):
+                raise InvalidParametersError("Failed to update the bond order parameters in the core.")
+
+
+    def run_monte_carlo(self, atoms, n_trials, temperature, max_displacement=0.1,
+                        max_charge_transfer=0.1, move_weights=(1.0,0.0,0.0), seed=None, skin=None):
+        """Runs a Metropolis Monte Carlo simulation of the given structure.
+
+        The simulation is run in the Fortran core. Each trial move is chosen randomly
+        according to the given weights among displacing a single atom randomly, swapping
+        the elements of two atoms of different elements, and transferring charge
+        between two atoms. The move is accepted with the probability 
+        :math:`\min(1,e^{-\Delta E / k_B T})`.
+
+        The energy change of each move is calculated locally from the interactions
+        around the changed atoms, including the bond order factors affected by the move
+        and the change in the reciprocal sum of Ewald summation. 
+        Therefore the cost of a trial does not grow with the size of the system.
+        The particle mesh Ewald method and additional calculators are not supported.
+
+        The given structure is modified in place: the positions, atomic numbers, 
+        masses (if set explicitly) and charges are updated. The tags, momenta and
+        constraints are not used. A swap exchanges the elements, masses and charges 
+        of the atoms, so the tags stay in place.
+
+        The numbers of attempted and accepted moves of each kind are
+        returned as arrays, along with the total change in energy.
+
+        Parameters:
+
+        atoms: `ASE Atoms`_ object
+            the structure to be simulated
+        n_trials: integer
+            the number of trial moves
+        temperature: double
+            the temperature in units of energy, :math:`k_B T`
+        max_displacement: double
+            the maximum displacement of an atom along each coordinate axis
+        max_charge_transfer: double
+            the maximum amount of charge transferred in a single move
+        move_weights: list of three doubles
+            the relative probabilities of displacement, swap and charge transfer moves
+        seed: integer
+            a seed for the random number generator, by default a random one
+        skin: double
+            the skin width of the neighbor lists used in the core, by default 
+            the larger of :data:`~pysic.calculator.FastNeighborList.neighbor_marginal`
+            and four times the maximum displacement
+        """
+        if self.coulomb is not None and self.coulomb.get_summation() == 'pme':
+            raise InvalidParametersError("Particle mesh Ewald summation is not supported in Monte Carlo simulations.")
+        if self.extra_calculators is not None and len(self.extra_calculators) > 0:
+            raise InvalidParametersError("Additional calculators are not supported in Monte Carlo simulations.")
+
+        weights = np.array(move_weights, dtype=float)
+        if len(weights) != 3 or (weights < 0.0).any() or weights.sum() <= 0.0:
+            raise InvalidParametersError("The move weights must be three non-negative numbers, not all zero.")
+        if skin is None:
+            skin = max(FastNeighborList.neighbor_marginal, 4.0*max_displacement)
+        elif skin < 2.0*math.sqrt(3.0)*max_displacement:
+            raise InvalidParametersError("The skin must be at least 2 sqrt(3) times the maximum displacement.")
+
+        self.set_atoms(atoms)
+        self.set_core()
+        if seed is None:
+            seed = np.random.randint(1, 2**31-1)
+        pf.pysic_interface.start_rng(seed)
+
+        # Swaps only permute the elements, so the largest cutoff does not change.
+        n_atoms = len(atoms)
+        cutoff = max(self.get_individual_cutoffs(1.0))
+        positions, charges, species, attempts, accepted, energy_change = \
+            pf.pysic_interface.run_monte_carlo(n_atoms, n_trials, temperature, weights,
+                                               max_displacement, max_charge_transfer,
+                                               cutoff, skin)
+
+        species = species - 1
+        if atoms.has('masses'):
+            atoms.set_masses(atoms.get_masses()[species])
+        atoms.set_atomic_numbers(atoms.get_atomic_numbers()[species])
+        atoms.arrays['positions'][:] = positions.T
+        # the call for charges was changed between ASE 3.6 and 3.7
+        try:
+            atoms.set_initial_charges(charges)
+        except:
+            atoms.set_charges(charges)
+
+        # The core already contains the new structure and its potential lists,
+        # but its neighbor lists were built for the simulation only.
+        self.set_atoms(atoms, system_changes=['positions', 'numbers', 'charges'])
+        Pysic.core.set_atomic_positions(self.structure, self.versions['positions'])
+        Pysic.core.set_charges(charges, self.versions['charges'])
+        Pysic.core.set_version('numbers', self.versions['numbers'])
+        Pysic.core.set_neighbor_lists(None)
+        Pysic.core.potential_lists_ready = True
+        self.neighbor_lists_waiting = False
+
+        return attempts, accepted, energy_change
+
+
+    def run_molecular_dynamics(self, atoms, n_steps, timestep, thermostat=None, temperature=0.0,
+                               friction=0.01, relaxation_time=None, sample_interval=1, 
+                               observer=None, seed=None):
+        """Runs molecular dynamics of the given structure in the Fortran core.
+
+        The equations of motion are integrated with the velocity Verlet algorithm
+        without returning to Python between the steps. The neighbor lists of the calculator 
+        are reused and rebuilt in the core when some atom has moved farther than half the skin.
+        The temperature can be controlled with a Langevin or a Berendsen thermostat.
+
+        A snapshot of the positions, momenta and energies is recorded every ``sample_interval`` steps
+        in preallocated arrays, which are returned as (positions, momenta, potential energies,
+        kinetic energies). The positions and momenta are arrays of shape (n_samples, n_atoms, 3).
+        The core only returns to Python when a snapshot is taken. If an ``observer`` is given, it is called
+        after each snapshot with the number of steps taken and the index of the snapshot, 
+        as ``observer(step, index)``.
+        Note that recording a snapshot requires the evaluation of the potential energy.
+
+        The given structure is modified in place: the positions and momenta are updated.
+        Atoms fixed with `FixAtoms`_ constraints do not move, other constraints are not supported.
+        Neither are charge relaxation and additional calculators.
+
+        Parameters:
+
+        atoms: `ASE Atoms`_ object
+            the structure to be simulated
+        n_steps: integer
+            the number of time steps
+        timestep: double
+            the length of the time step, in ASE units of time
+        thermostat: string
+            None for constant energy, 'langevin' or 'berendsen'
+        temperature: double
+            the temperature of the thermostat in units of energy, :math:`k_B T`
+        friction: double
+            the friction coefficient of the Langevin thermostat, in inverse units of time
+        relaxation_time: double
+            the time constant of the Berendsen thermostat, by default 100 time steps
+        sample_interval: integer
+            the number of steps between snapshots
+        observer: function
+            a function called after each snapshot
+        seed: integer
+            a seed for the random number generator of the Langevin thermostat, by default a random one
+        """
+        thermostats = {None: 0, 'langevin': 1, 'berendsen': 2}
+        if thermostat not in thermostats:
+            raise InvalidParametersError("Unknown thermostat '"+str(thermostat)+"', use 'langevin' or 'berendsen'.")
+        if self.charge_relaxation is not None:
+            raise InvalidParametersError("Charge relaxation is not supported in molecular dynamics in the core.")
+        if self.extra_calculators is not None and len(self.extra_calculators) > 0:
+            raise InvalidParametersError("Additional calculators are not supported in molecular dynamics in the core.")
+        if sample_interval < 1:
+            raise InvalidParametersError("The sample interval must be at least one step.")
+        if thermostat == 'berendsen':
+            if relaxation_time is None:
+                relaxation_time = 100.0*timestep
+            coupling = relaxation_time
+        else:
+            coupling = friction
+        fixed = fixed_atoms_mask(atoms)
+
+        self.set_atoms(atoms)
+        self.set_core()
+        if thermostat == 'langevin':
+            if seed is None:
+                seed = np.random.randint(1, 2**31-1)
+            pf.pysic_interface.start_rng(seed)
+
+        n_atoms = len(atoms)
+        cutoffs = self.neighbor_list.cutoffs
+        skin = self.neighbor_list.skin
+        n_samples = n_steps // sample_interval
+        positions = np.empty([n_samples, n_atoms, 3])
+        momenta = np.empty([n_samples, n_atoms, 3])
+        potential_energies = np.empty(n_samples)
+        kinetic_energies = np.empty(n_samples)
+        # The core works on the transposes of these C-ordered arrays, 
+        # so the snapshots are written in place.
+        forces = np.empty([n_atoms, 3])
+        forces_ready = False
+        final_positions = np.empty([n_atoms, 3])
+        final_momenta = np.empty([n_atoms, 3])
+
+        steps_taken = 0
+        while steps_taken < n_steps:
+            n_run = min(sample_interval, n_steps - steps_taken)
+            index = steps_taken // sample_interval
+            if n_run == sample_interval:
+                step_positions = positions[index]
+                step_momenta = momenta[index]
+            else:
+                step_positions = final_positions
+                step_momenta = final_momenta
+            energy, kinetic, rebuilds = pf.pysic_interface.run_molecular_dynamics(n_run, timestep,
+                                                                                  thermostats[thermostat],
+                                                                                  temperature, coupling,
+                                                                                  cutoffs, skin, fixed,
+                                                                                  forces.T, forces_ready,
+                                                                                  step_positions.T,
+                                                                                  step_momenta.T)
+            forces_ready = True
+            steps_taken += n_run
+            self.neighbor_list_rebuilds += rebuilds
+            if n_run == sample_interval:
+                potential_energies[index] = energy
+                kinetic_energies[index] = kinetic
+                if observer is not None:
+                    observer(steps_taken, index)
+
+        if n_steps > n_samples*sample_interval:
+            atoms.arrays['positions'][:] = final_positions
+            atoms.set_momenta(final_momenta)
+        elif n_samples > 0:
+            atoms.arrays['positions'][:] = positions[-1]
+            atoms.set_momenta(momenta[-1])
+
+        # The core already contains the new positions and momenta,
+        # but its neighbor lists were rebuilt in the core only.
+        self.set_atoms(atoms, system_changes=['positions', 'momenta'])
+        Pysic.core.set_atomic_positions(self.structure, self.versions['positions'])
+        Pysic.core.set_atomic_momenta(self.structure, self.versions['momenta'])
+        Pysic.core.set_neighbor_lists(None)
+        self.neighbor_lists_waiting = False
+
+        return positions, momenta, potential_energies, kinetic_energies
+
+
+    def run_fire_relaxation(self, atoms, fmax=0.05, max_steps=1000, relax_cell=False, cell_mask=None,
+                            record_energies=False, timestep=0.1, max_move=0.2, max_timestep=1.0, 
+                            n_min=5, f_inc=1.1, f_dec=0.5, a_start=0.1, f_a=0.99):
+        """Relaxes the given structure with the FIRE algorithm in the Fortran core.
+
+        The fast inertial relaxation engine (FIRE) is run as the FIRE optimizer of `ASE`_, 
+        with the same parameters, but the whole relaxation is done in the core
+        without returning to Python between the steps. The neighbor lists of the calculator
+        are reused and only rebuilt when needed.
+
+        If ``relax_cell`` is True, also the shape of the supercell is relaxed 
+        according to the stress, as with the UnitCellFilter of `ASE`_. The components 
+        :math:`[xx,yy,zz,yz,xz,xy]` of the strain to be relaxed can be chosen with ``cell_mask``.
+        The convergence criterion then also applies to the stress components multiplied by the volume.
+        The kinetic part of the stress is ignored.
+
+        The given structure is modified in place: the positions (and the cell) are updated.
+        Atoms fixed with `FixAtoms`_ constraints do not move, other constraints are not supported.
+        Neither are charge relaxation and additional calculators.
+
+        Returns a tuple (converged, n_steps, force_history, energy_history), where
+        converged is True if the largest force dropped below ``fmax``, n_steps is the number of steps taken,
+        and the histories contain the largest force and the potential energy before each step and at the end.
+        The energies are only recorded if ``record_energies`` is True, since they require
+        an additional evaluation on each step. Otherwise, the energy history is None.
+
+        Parameters:
+
+        atoms: `ASE Atoms`_ object
+            the structure to be relaxed
+        fmax: double
+            the convergence criterion for the largest force
+        max_steps: integer
+            the maximum number of steps
+        relax_cell: logical
+            if True, also the cell is relaxed
+        cell_mask: list of six logicals
+            the strain components which are relaxed, by default all
+        record_energies: logical
+            if True, the potential energy is recorded on every step
+        timestep: double
+            the initial time step
+        max_move: double
+            the maximum length of a step of the whole system
+        max_timestep: double
+            the maximum time step
+        n_min: integer
+            the number of steps with positive power before the time step is increased
+        f_inc: double
+            the factor for increasing the time step
+        f_dec: double
+            the factor for decreasing the time step
+        a_start: double
+            the initial mixing of the velocities with the forces
+        f_a: double
+            the factor for decreasing the mixing
+        """
+        if self.charge_relaxation is not None:
+            raise InvalidParametersError("Charge relaxation is not supported in relaxation in the core.")
+        if self.extra_calculators is not None and len(self.extra_calculators) > 0:
+            raise InvalidParametersError("Additional calculators are not supported in relaxation in the core.")
+        if cell_mask is None:
+            cell_mask = [True]*6
+        elif len(cell_mask) != 6:
+            raise InvalidParametersError("The cell mask must contain six logical values.")
+        fixed = fixed_atoms_mask(atoms)
+
+        self.set_atoms(atoms)
+        self.set_core()
+
+        parameters = np.array([timestep, max_move, max_timestep, f_inc, f_dec, a_start, f_a])
+        force_history = np.zeros(max_steps+1)
+        energy_history = np.zeros(max_steps+1)
+        # the core writes the positions directly in the structure
+        vectors, n_steps, converged, rebuilds = \
+            pf.pysic_interface.run_fire_relaxation(max_steps, fmax, parameters,
+                                                   n_min, relax_cell, cell_mask,
+                                                   self.neighbor_list.cutoffs, self.neighbor_list.skin,
+                                                   fixed, record_energies,
+                                                   atoms.arrays['positions'].T, 
+                                                   force_history, energy_history)
+        self.neighbor_list_rebuilds += rebuilds
+        if relax_cell:
+            atoms.set_cell(vectors.T, scale_atoms=False)
+
+        # The core already contains the new positions, but its neighbor lists 
+        # were rebuilt in the core only. A new cell is sent to the core again.
+        self.set_atoms(atoms, system_changes=['positions', 'cell'] if relax_cell else ['positions'])
+        Pysic.core.set_atomic_positions(self.structure, self.versions['positions'])
+        Pysic.core.set_neighbor_lists(None)
+        self.neighbor_lists_waiting = False
+
+        force_history = force_history[:n_steps+1]
+        if record_energies:
+            energy_history = energy_history[:n_steps+1]
+        else:
+            energy_history = None
+        return bool(converged), n_steps, force_history, energy_history
+
+
+    def set_atoms(self, atoms=None, system_changes=None):
         """Assigns the calculator with the given structure.
             
         This method is always called when any method is given the
@@ -543,61 +1827,122 @@ class Pysic:
         is saved (according to the instructions in 
         `ASE API <https://wiki.fysik.dtu.dk/ase/ase/calculators/calculators.html#calculator-interface>`_.)
             
-        If a structure is already in memory and it is different to the given
-        one (as compared with ``__ne__``), it is noted that all quantities
+        The changes with respect to the structure already in memory are
+        listed as in `ASE`_ with :meth:`~pysic.calculator.Pysic.check_state`,
+        unless the list is given as the ``system_changes`` argument. If the caller
+        knows what has been changed (say, a molecular dynamics integrator only moving
+        the atoms), giving the list saves the comparison of the structures.
+        The recognized changes are listed in :data:`~pysic.calculator.Pysic.all_changes`,
+        others are ignored.
+
+        For every change, the version of the corresponding data is renewed
+        so that :data:`~pysic.calculator.Pysic.core` knows what needs to be
+        updated in the core. If the structure has changed, it is noted that all quantities
         are unknown for the new system. If the structure is the same as the
         one already known, nothing is done.
         This is because if one wants to
         access the energy of forces of the same system repeatedly, it is unnecessary
         to always calculate them from scratch. Therefore the calculator saves
         the computed values along with a flag stating that the values have been
-        computed.
+        computed. The momenta do not affect the energy or the forces, so if
+        only the momenta have changed, the computed values are kept.
             
         Parameters:
 
         atoms: `ASE atoms`_ object
             the structure to be calculated
+        system_changes: list of strings
+            the changes in the structure, if known
         """
-        if atoms == None:
-            pass
+        if atoms is None:
+            return
+
+        if self.structure is None or len(self.structure) != len(atoms):
+            changes = Pysic.all_changes
+        elif system_changes is None:
+            changes = self.check_state(atoms)
         else:
-            atoms_changed = False
-            
-            # the call for charges was changed between ASE 3.6 and 3.7
-            try:
-                atoms_changed = self.structure != atoms or \
-                    (self.structure.get_initial_charges() != atoms.get_initial_charges()).any()
-            except:
-                atoms_changed = self.structure != atoms or \
-                    (self.structure.get_charges() != atoms.get_charges()).any()
-
-            if(atoms_changed):
-                self.forces = None
-                self.energy = None
-                self.stress = None
-                self.electronegativities = None
-                
+            changes = [ change for change in system_changes if change in Pysic.all_changes ]
 
-                # NB: this avoids updating the potential lists every time an atom moves
-                try:
-                    if((self.structure.get_atomic_numbers() != atoms.get_atomic_numbers()).any()):
-                        Pysic.core.potential_lists_ready = False
-                        self.neighbor_lists_waiting = False
+        if len(changes) == 0:
+            return
+
+        for change in changes:
+            self.versions[Pysic.change_versions[change]] = CoreMirror.new_version()
+
+        if any( change != 'momenta' for change in changes ):
+            self.forces = None
+            self.energy = None
+            self.stress = None
+            self.energies = None
+            self.virials = None
+            self.electronegativities = None
 
-                    if((self.structure.get_tags() != atoms.get_tags()).any()):
-                        Pysic.core.potential_lists_ready = False
-                        self.neighbor_lists_waiting = False                
+        # NB: this avoids updating the potential lists every time an atom moves
+        if 'numbers' in changes or 'tags' in changes:
+            Pysic.core.potential_lists_ready = False
+            self.neighbor_lists_waiting = False
 
-                    if(not Pysic.core.potentials_ready(self.potentials)):
-                        Pysic.core.potential_lists_ready = False
-                        self.neighbor_lists_waiting = False
+        self.structure = atoms.copy()
 
-                except:
-                    Pysic.core.potential_lists_ready = False
-                    self.neighbor_lists_waiting = False
-            
 
-                self.structure = atoms.copy()
+    def check_state(self, atoms):
+        """Lists the changes in the given structure with respect to the one assigned to the calculator.
+
+        The changes are listed as in `ASE`_, the possible ones being 
+        :data:`~pysic.calculator.Pysic.all_changes`.
+
+        Parameters:
+
+        atoms: `ASE atoms`_ object
+            the structure to be compared
+        """
+        if self.structure is None or len(self.structure) != len(atoms):
+            return list(Pysic.all_changes)
+
+        changes = []
+        if (self.structure.get_positions() != atoms.get_positions()).any():
+            changes.append('positions')
+        if (self.structure.get_momenta() != atoms.get_momenta()).any():
+            changes.append('momenta')
+        if (self.structure.get_atomic_numbers() != atoms.get_atomic_numbers()).any():
+            changes.append('numbers')
+        if (self.structure.get_tags() != atoms.get_tags()).any():
+            changes.append('tags')
+        if (self.structure.get_masses() != atoms.get_masses()).any():
+            changes.append('masses')
+        if (self.structure.get_cell() != atoms.get_cell()).any():
+            changes.append('cell')
+        if (self.structure.get_pbc() != atoms.get_pbc()).any():
+            changes.append('pbc')
+        # the call for charges was changed between ASE 3.6 and 3.7
+        try:
+            if (self.structure.get_initial_charges() != atoms.get_initial_charges()).any():
+                changes.append('initial_charges')
+        except:
+            if (self.structure.get_charges() != atoms.get_charges()).any():
+                changes.append('initial_charges')
+
+        return changes
+
+
+    def check_interactions(self):
+        """Renews the versions of the potentials and the Coulomb summation if they have been edited.
+
+        The potentials and the summation algorithm may be edited in place 
+        without telling the calculator, so they are compared through their 
+        fingerprints (see :meth:`~pysic.core.CoreMirror.fingerprint`) with the ones
+        recorded the last time they were checked.
+        """
+        # the potentials created in the core also depend on the tabulation settings
+        potential_data = self.potentials
+        if self.pair_tabulation is not None:
+            potential_data = [self.potentials, self.pair_tabulation.get_settings()]
+        for key, data in [['potentials', potential_data], ['coulomb', self.coulomb]]:
+            fingerprint = CoreMirror.fingerprint(data)
+            if fingerprint is None or fingerprint != self.fingerprints[key]:
+                self.fingerprints[key] = fingerprint
+                self.versions[key] = CoreMirror.new_version()
 
 
     def set_potentials(self, potentials):
@@ -620,6 +1965,8 @@ class Pysic:
             self.forces = None
             self.energy = None
             self.stress = None
+            self.energies = None
+            self.virials = None
             self.electronegativities = None
             
             new_cutoffs = self.get_individual_cutoffs(1.0)
@@ -657,6 +2004,8 @@ class Pysic:
         self.forces = None
         self.energy = None
         self.stress = None
+        self.energies = None
+        self.virials = None
         self.electronegativities = None
 
 
@@ -694,6 +2043,8 @@ class Pysic:
         self.forces = None
         self.energy = None
         self.stress = None
+        self.energies = None
+        self.virials = None
         self.electronegativities = None
 
         new_cutoffs = self.get_individual_cutoffs(1.0)
@@ -756,6 +2107,109 @@ class Pysic:
         """Returns the Coulomb summation algorithm of this calculator.
             """
         return self.coulomb
+
+
+    def set_pair_tabulation(self,tabulation):
+        """Switches the tabulation of pair potentials on or off.
+
+            If a :class:`~pysic.interactions.tabulation.PairTabulation` is given,
+            the pair potentials acting on each pair of elements are summed,
+            including their smooth cutoffs, and tabulated in a single table 
+            when the potentials are created in the core. The core then evaluates 
+            one tabulated potential per pair of atoms instead of all the potentials separately.
+            The tables are validated against the potentials, and the results are
+            available from :meth:`~pysic.interactions.tabulation.PairTabulation.get_report`.
+
+            The tabulated potentials are not present in the core as such, so they cannot be 
+            used in :meth:`~pysic.calculator.Pysic.evaluate_parameter_sweep` or
+            :meth:`~pysic.calculator.Pysic.calculate_parameter_gradients`.
+
+            Parameters:
+
+            tabulation: :class:`~pysic.interactions.tabulation.PairTabulation` object
+                the tabulation settings, None for evaluating the potentials directly
+            """
+        if tabulation is not None and not isinstance(tabulation, PairTabulation):
+            raise InvalidParametersError("The pair tabulation must be given as a PairTabulation object.")
+        self.pair_tabulation = tabulation
+        self.forces = None
+        self.energy = None
+        self.stress = None
+        self.energies = None
+        self.virials = None
+        self.electronegativities = None
+
+
+    def get_pair_tabulation(self):
+        """Returns the tabulation of pair potentials of this calculator, or None if the potentials are not tabulated.
+            """
+        return self.pair_tabulation
+
+
+    def set_number_of_threads(self,n_threads):
+        """Sets the number of threads used for evaluating the local interactions.
+
+            The atoms are divided between the threads and each thread sums up
+            its contributions to the energy, forces, electronegativities and stress
+            separately. These partial results are then summed in a fixed order, so
+            the results do not depend on how the threads happen to be scheduled.
+
+            Threads are only available if the Fortran core has been compiled with
+            OpenMP support (see the ``openmp`` target in the Makefile). Without it,
+            the evaluation is always serial. Potentials with bond order factors
+            as well as the reciprocal space part of Coulomb summation
+            are always evaluated in a single thread.
+
+            Parameters:
+
+            n_threads: integer
+                the number of threads
+            """
+        if n_threads < 1:
+            raise InvalidParametersError("The number of threads must be positive.")
+        self.n_threads = int(n_threads)
+        pf.pysic_interface.set_number_of_threads(self.n_threads)
+        if pf.pysic_interface.get_number_of_threads() < self.n_threads:
+            warn("The Pysic core has been compiled without OpenMP, so the calculation is done in a single thread.",2)
+
+
+    def get_number_of_threads(self):
+        """Returns the number of threads requested for evaluating the local interactions.
+            """
+        return self.n_threads
+
+
+    def set_spatial_ordering(self,ordered=True):
+        """Switches the spatial ordering of atoms in the Fortran core on or off.
+
+            If switched on, the core stores the atoms ordered along a space-filling
+            (Morton) curve through the subcells used for neighbor searching.
+            The order is updated every time the neighbor lists are rebuilt.
+            Atoms that are close to each other in space are then also close to each other
+            in memory, which makes the evaluation of local interactions faster for
+            large systems where the data of all atoms does not fit in the processor cache.
+
+            The reordering is invisible outside the core: positions, charges and
+            other data are given to the core and forces, electronegativities,
+            neighbor lists etc. are returned in the order of the atoms in the
+            `ASE Atoms`_ object. The results may differ from the unordered ones
+            by rounding errors due to a different order of summation.
+
+            .. _ASE Atoms: https://wiki.fysik.dtu.dk/ase/ase/atoms.html
+
+            Parameters:
+
+            ordered: logical
+                True if the atoms should be ordered spatially
+            """
+        self.spatial_ordering = bool(ordered)
+        pf.pysic_interface.set_spatial_ordering(self.spatial_ordering)
+
+
+    def get_spatial_ordering(self):
+        """Returns True if the atoms are ordered spatially in the Fortran core.
+            """
+        return self.spatial_ordering
     
     
     def set_charge_relaxation(self,charge_relaxation):
@@ -856,8 +2310,33 @@ class Pysic:
         """
         return self.neighbor_list
     
+    
+    def get_number_of_neighbor_list_rebuilds(self):
+        """Returns the number of times the neighbor lists have been built by the calculator.
+        
+        The count is zeroed by :meth:`~pysic.calculator.Pysic.reset_neighbor_list_statistics`.
+        """
+        return self.neighbor_list_rebuilds
+    
+    
+    def get_number_of_neighbor_list_reuses(self):
+        """Returns the number of times the atomic coordinates have been updated without rebuilding the neighbor lists.
+        
+        The lists need not be rebuilt as long as no atom has moved more than half the
+        skin width of the lists, see :meth:`~pysic.calculator.FastNeighborList.update`.
+        The count is zeroed by :meth:`~pysic.calculator.Pysic.reset_neighbor_list_statistics`.
+        """
+        return self.neighbor_list_reuses
+    
+    
+    def reset_neighbor_list_statistics(self):
+        """Zeroes the counters of neighbor list rebuilds and reuses.
+        """
+        self.neighbor_list_rebuilds = 0
+        self.neighbor_list_reuses = 0
+    
             
-    def get_individual_cutoffs(self,scaler=1.0):
+    def get_individual_cutoffs(self,scaler=1.0,atoms=None):
         """Get a list of maximum cutoffs for all atoms.
 
         For each atom, the interaction with the longest cutoff is found and
@@ -869,21 +2348,25 @@ class Pysic:
 
         scaler: double
             a number for scaling all values in the generated list
+        atoms: `ASE Atoms`_ object
+            the structure whose cutoffs are listed, by default the one assigned to the calculator
         """
-        if self.structure == None:
+        if atoms is None:
+            atoms = self.structure
+        if atoms == None:
             return None
         elif self.potentials == None:
             if self.coulomb == None:
-                return self.structure.get_number_of_atoms()*[0.0]
+                return atoms.get_number_of_atoms()*[0.0]
             else:
-                return self.structure.get_number_of_atoms()*[self.coulomb.get_realspace_cutoff()]
+                return atoms.get_number_of_atoms()*[self.coulomb.get_realspace_cutoff()]
         else:
             cuts = []            
             # loop over all atoms, with symbol, tags, index containing the corresponding
             # info for a single atom at a time
-            for symbol, tags, index in zip(self.structure.get_chemical_symbols(),
-                                           self.structure.get_tags(),
-                                           range(self.structure.get_number_of_atoms())):
+            for symbol, tags, index in zip(atoms.get_chemical_symbols(),
+                                           atoms.get_tags(),
+                                           range(atoms.get_number_of_atoms())):
             
                 if self.coulomb == None:
                     max_cut = 0.0
@@ -925,20 +2408,36 @@ class Pysic:
         self.electronegativities = pf.pysic_interface.calculate_electronegativities(n_atoms).transpose()
         
     
-    def calculate_forces(self, skip_charge_relaxation=False):
+    def calculate_forces(self, skip_charge_relaxation=False, out=None):
         """Calculates forces (and the potential part of the stress tensor).
 
         Calls the Fortran core to calculate forces for the currently assigned structure.
             
         If a link exists to a :class:`~pysic.charges.relaxation.ChargeRelaxation`, it is first made to
         relax the atomic charges before the forces are calculated.
+
+        The core writes the forces directly in a C-ordered array of shape (n_atoms, 3).
+        If such an array is given as ``out``, it is filled and the forces are not stored 
+        in the calculator, since the caller owns the array. Otherwise a new array is created.
+
+        Parameters:
+
+        skip_charge_relaxation: logical
+            if True, the charge relaxation is not done
+        out: numpy array of doubles
+            the array in which the forces are written, see :meth:`~pysic.calculator.Pysic.compute_forces`
         """
         self.set_core()
         if self.charge_relaxation is not None and skip_charge_relaxation == False:
             self.charge_relaxation.charge_relaxation()
         n_atoms = pf.pysic_interface.get_number_of_atoms()
-        self.forces, self.stress = pf.pysic_interface.calculate_forces(n_atoms)#.transpose()
-        self.forces = self.forces.transpose()
+        if out is None:
+            forces = np.empty([n_atoms,3])
+        else:
+            forces = out
+        # the transpose of a C-ordered (n_atoms, 3) array is the Fortran-ordered
+        # (3, n_atoms) array the core expects, so it is filled without copying
+        self.stress = pf.pysic_interface.calculate_forces(forces.T)
 
         if not self.extra_calculators is None:
             if len(self.extra_calculators) > 0:
@@ -947,52 +2446,84 @@ class Pysic:
                 # give a copy though, just in case? Will take more memory though.
                 system_copy = copy.deepcopy(self.structure)
                 for calc in self.extra_calculators:
-                    self.forces = self.forces + calc.get_forces(system_copy)
+                    forces += calc.get_forces(system_copy)
                     self.stress = self.stress + calc.get_stress(system_copy)
+
+        if out is None:
+            self.forces = forces
+        else:
+            self.forces = None
         
         
 
-    def calculate_energy(self, skip_charge_relaxation=False):
+    def calculate_energy(self, skip_charge_relaxation=False, atom_contributions=False):
         """Calculates the potential energy.
 
         Calls the Fortran core to calculate the potential energy for the currently assigned structure.
  
         If a link exists to a :class:`~pysic.charges.relaxation.ChargeRelaxation`, it is first made to
         relax the atomic charges before the forces are calculated.
+
+        Parameters:
+
+        skip_charge_relaxation: logical
+            if True, the charge relaxation is not done
+        atom_contributions: logical
+            if True, also the energies of the atoms are calculated, see :meth:`~pysic.calculator.Pysic.get_potential_energies`
         """
         self.set_core()
 
         if self.charge_relaxation is not None and skip_charge_relaxation == False:
             self.charge_relaxation.charge_relaxation()
-        #n_atoms = pf.pysic_interface.get_number_of_atoms()
+        n_atoms = pf.pysic_interface.get_number_of_atoms()
+        pf.pysic_interface.set_atom_contributions(atom_contributions)
         self.energy = pf.pysic_interface.calculate_energy()
+        if atom_contributions:
+            pf.pysic_interface.set_atom_contributions(False)
+            self.energies = pf.pysic_interface.get_atom_energies(n_atoms)
 
         if not self.extra_calculators is None:
             if len(self.extra_calculators) > 0:
                 system_copy = copy.deepcopy(self.structure)
                 for calc in self.extra_calculators:
                     self.energy = self.energy + calc.get_potential_energy(system_copy)
+                    if atom_contributions:
+                        self.energies = self.energies + calc.get_potential_energies(system_copy)
 
 
-    def calculate_stress(self, skip_charge_relaxation=False):
+    def calculate_stress(self, skip_charge_relaxation=False, atom_contributions=False):
         """Calculates the potential part of the stress tensor (and forces).
 
         Calls the Fortran core to calculate the stress tensor for the currently assigned structure.
+
+        Parameters:
+
+        skip_charge_relaxation: logical
+            if True, the charge relaxation is not done
+        atom_contributions: logical
+            if True, also the virials of the atoms are calculated, see :meth:`~pysic.calculator.Pysic.get_stresses`
         """
 
-        if self.charge_relaxation is not None and skip_charge_relaxation == False:            self.charge_relaxation.charge_relaxation()
-        
         self.set_core()
+        if self.charge_relaxation is not None and skip_charge_relaxation == False:
+            self.charge_relaxation.charge_relaxation()
+
         n_atoms = pf.pysic_interface.get_number_of_atoms()
-        self.forces, self.stress = pf.pysic_interface.calculate_forces(n_atoms)
-        self.forces = self.forces.transpose()
+        self.forces = np.empty([n_atoms,3])
+        pf.pysic_interface.set_atom_contributions(atom_contributions)
+        self.stress = pf.pysic_interface.calculate_forces(self.forces.T)
+        if atom_contributions:
+            pf.pysic_interface.set_atom_contributions(False)
+            self.virials = pf.pysic_interface.get_atom_virials(n_atoms).T
 
         if not self.extra_calculators is None:
             if len(self.extra_calculators) > 0:
-                system_copy = copy.deepcopy(self.system)
+                system_copy = copy.deepcopy(self.structure)
                 for calc in self.extra_calculators:
                     self.forces = self.forces + calc.get_forces(system_copy)
                     self.stress = self.stress + calc.get_stress(system_copy)
+                    if atom_contributions:
+                        self.virials = self.virials + calc.get_stresses(system_copy)
 
 
     def set_core(self):
@@ -1004,44 +2535,64 @@ class Pysic:
         Potentials, neighbor lists etc. are also updated if they have been edited.
         """        
         
+        core = Pysic.core
+        self.check_interactions()
+
         do_full_init = False
         if self.force_core_initialization:
             do_full_init = True
-        elif not Pysic.core.mpi_ready:
+        elif not core.mpi_ready:
             do_full_init = True
-        elif Pysic.core.get_atoms() == None:
+        elif core.get_atoms() is None:
             do_full_init = True
-        elif self.structure.get_number_of_atoms() != Pysic.core.structure.get_number_of_atoms():
+        elif self.structure.get_number_of_atoms() != core.structure.get_number_of_atoms():
             do_full_init = True
         elif self.structure.get_number_of_atoms() != pf.pysic_interface.get_number_of_atoms():
             do_full_init = True
+        elif not core.is_current('numbers', self.versions['numbers']):
+            # the elements, tags and masses are only set in a full initialization,
+            # but another calculator may have set the same ones
+            if core.composition_ready(self.structure):
+                core.set_version('numbers', self.versions['numbers'])
+            else:
+                do_full_init = True
+
+        # the thread count and the ordering are shared by all calculators using the core
+        pf.pysic_interface.set_number_of_threads(self.n_threads)
+        pf.pysic_interface.set_spatial_ordering(self.spatial_ordering)
             
         if do_full_init:
             self.initialize_fortran_core()
         else:
-            if not Pysic.core.cell_ready(self.structure):
+            # Only the data whose version differs from the one in the core is updated.
+            # In particular, the momenta are not used in the calculations, so they
+            # are only sent to the core along with the positions.
+            if not core.is_current('cell', self.versions['cell']):
                 self.update_core_supercell()
+                # the k-space summation limits depend on the cell
+                if self.coulomb != None:
+                    self.update_core_coulomb()
             
-            if not Pysic.core.atoms_ready(self.structure):
+            if not core.is_current('positions', self.versions['positions']):
                 self.update_core_coordinates()
             
-            if not Pysic.core.charges_ready(self.structure):
+            if not core.is_current('charges', self.versions['charges']):
                 self.update_core_charges()
                     
-            if not Pysic.core.potentials_ready(self.potentials):
+            if not core.is_current('potentials', self.versions['potentials']):
                 self.update_core_potentials()
 
             if self.coulomb != None:
-                if not Pysic.core.coulomb_summation_ready(self.coulomb):
+                if not core.is_current('coulomb', self.versions['coulomb']):
                     self.update_core_coulomb()
             
-            if not Pysic.core.potential_lists_ready:
+            if not core.potential_lists_ready:
                 self.update_core_potential_lists()
 
             if not self.neighbor_lists_waiting:
                 self.create_neighbor_lists(self.get_individual_cutoffs(1.0))
 
-            if not Pysic.core.neighbor_lists_ready(self.neighbor_list):
+            if not core.neighbor_lists_ready(self.neighbor_list):
                 self.update_core_neighbor_lists()
                 
 
@@ -1053,7 +2604,7 @@ class Pysic:
         of such potentials for every particle. This method asks the core to
         generate these lists.
         """
-        if not Pysic.core.atoms_ready(self.structure):
+        if not Pysic.core.is_current('positions', self.versions['positions']):
             raise MissingAtomsError("Creating potential lists before updating atoms in core.")
         pf.pysic_interface.create_potential_list()
         pf.pysic_interface.create_bond_order_factor_list()
@@ -1064,12 +2615,18 @@ class Pysic:
         """Generates potentials for the Fortran core."""
         
         Pysic.core.potential_lists_ready = False
+        self.core_potential_map = []
+        self.core_multipliers = []
+        self.n_core_potentials = 0
+        self.core_bond_order_map = []
+        Pysic.core.mark_tables_unused()
         if self.potentials == None:
             pf.pysic_interface.allocate_potentials(0)
             pf.pysic_interface.allocate_bond_order_factors(0)
             
             n_atoms = pf.pysic_interface.get_number_of_atoms()
             pf.pysic_interface.allocate_bond_order_storage(n_atoms,0,0)
+            Pysic.core.release_unused_tables()
             warn("There are no potentials associated with the Pysic calculator!",2)
             return
 
@@ -1078,14 +2635,20 @@ class Pysic:
             pf.pysic_interface.allocate_bond_order_factors(0)
             n_atoms = pf.pysic_interface.get_number_of_atoms()
             pf.pysic_interface.allocate_bond_order_storage(n_atoms,0,0)
+            Pysic.core.release_unused_tables()
             warn("There are no potentials associated with the Pysic calculator!",2)
             return
+
+        # the tabulated pair potentials replace the potentials they combine
+        potentials = self.potentials
+        if self.pair_tabulation is not None:
+            potentials = self.pair_tabulation.tabulate(self.potentials, self.get_core_parameters)
         
         n_pots = 0
         coord_list = []
         pot_index = 0
         # count the number of separate potentials
-        for pot in self.potentials:
+        for pot in potentials:
 
             # grab the coordinators associated with the potentials
             # but check that each coordinator is included only once
@@ -1196,7 +2759,7 @@ class Pysic:
         elemental_potentials = []
         is_multiplier = []
         master_potentials = []
-        for pots in self.potentials:
+        for pots in potentials:
         
             # warn for missing cutoffs
             if pots.get_number_of_targets() > 1 and pots.get_cutoff() < 0.01:
@@ -1263,7 +2826,7 @@ class Pysic:
 
                         if not mul or not multiplier_added:
                             success = pf.pysic_interface.add_potential(pot.get_potential_type(),
-                                                         np.array( pot.get_parameter_values() ),
+                                                         self.get_core_parameters(pot),
                                                          mpot.get_cutoff(),
                                                          mpot.get_soft_cutoff(),
                                                          np.array( int_symbs ).transpose(),
@@ -1275,6 +2838,8 @@ class Pysic:
                                                          group_index,
                                                          mul )
                             multiplier_added = True
+                            if success:
+                                self.record_core_potential(pot, mul)
                         else:
                             success = True
 
@@ -1302,7 +2867,7 @@ class Pysic:
                         if not mul or not multiplier_added:
                         
                             success = pf.pysic_interface.add_potential(pot.get_potential_type(),
-                                                         np.array( pot.get_parameter_values() ),
+                                                         self.get_core_parameters(pot),
                                                          mpot.get_cutoff(),
                                                          mpot.get_soft_cutoff(),
                                                          no_symbs,
@@ -1315,6 +2880,8 @@ class Pysic:
                                                          mul)
                         
                             multiplier_added = True
+                            if success:
+                                self.record_core_potential(pot, mul)
                         else:
                             success = True
                         
@@ -1342,7 +2909,7 @@ class Pysic:
                         if not mul or not multiplier_added:
                         
                             success = pf.pysic_interface.add_potential(pot.get_potential_type(),
-                                                         np.array( pot.get_parameter_values() ),
+                                                         self.get_core_parameters(pot),
                                                          mpot.get_cutoff(),
                                                          mpot.get_soft_cutoff(),
                                                          no_symbs,
@@ -1354,6 +2921,8 @@ class Pysic:
                                                          group_index,
                                                          mul )
                             multiplier_added = True
+                            if success:
+                                self.record_core_potential(pot, mul)
                         else:
                             success = True
 
@@ -1367,6 +2936,7 @@ class Pysic:
                         
             if not mul:
                 pf.pysic_interface.clear_potential_multipliers()
+                self.core_multipliers = []
 
         n_bonds = 0
         permutate = False
@@ -1421,7 +2991,7 @@ class Pysic:
                                 int_symbs.append( pu.str2ints(label,2) )
 
                             success = pf.pysic_interface.add_bond_order_factor(bond.get_bond_order_type(),
-                                                                   np.array( bond.get_parameters_as_list() ),
+                                                                   self.get_core_parameters(bond),
                                                                    np.array( bond.get_number_of_parameters() ),
                                                                    bond.get_cutoff(),
                                                                    bond.get_soft_cutoff(),
@@ -1430,6 +3000,7 @@ class Pysic:
                                                                    coord[1])
                             if not success:
                                 raise InvalidParametersError("")
+                            self.core_bond_order_map.append([bond, len(self.core_bond_order_map)])
 
 
             except:
@@ -1439,14 +3010,79 @@ class Pysic:
         pf.pysic_interface.allocate_bond_order_storage(n_atoms,
                                                        pot_index,
                                                        len(coord_list))
+        Pysic.core.release_unused_tables()
 
-        Pysic.core.set_potentials(self.potentials)
+        Pysic.core.set_potentials(self.potentials, self.versions['potentials'])
 
 
         self.neighbor_lists_waiting = False
 
 
             
+    def get_core_parameters(self, interaction, values=None):
+        """Returns the parameters of a potential or a bond order factor in the form given to the core.
+
+        The parameters are returned as a single array. Tabulated potentials and
+        bond order factors get their tables from :meth:`~pysic.interactions.local.Potential.get_table`
+        or, if no table is given, from the file specified by the id parameter, see
+        :func:`~pysic.interactions.tables.get_numbered_table`. The table is stored in the core 
+        with :meth:`~pysic.core.CoreMirror.store_table` and the id is replaced by 
+        the negative index of the stored table, counting from -1.
+
+        Parameters:
+
+        interaction: :class:`~pysic.interactions.local.Potential` or :class:`~pysic.interactions.bondorder.BondOrderParameters` object
+            the potential or the bond order factor
+        values: list of doubles
+            if given, these parameters are used instead of the current parameters of the interaction
+        """
+        if isinstance(interaction, BondOrderParameters):
+            if values is None:
+                values = interaction.get_parameters_as_list()
+            tabulated = interaction.get_bond_order_type() in ('table_bond', 'table_scale')
+        else:
+            if values is None:
+                values = interaction.get_parameter_values()
+            tabulated = interaction.get_potential_type() == 'tabulated'
+        values = np.array(values, dtype=float)
+
+        if tabulated:
+            # the id is the first parameter of all tabulated interactions
+            table = interaction.get_table()
+            if table is None:
+                table = get_numbered_table(int(values[0]))
+            values[0] = -(Pysic.core.store_table(table)+1)
+        return values
+
+
+    def record_core_potential(self, potential, is_multiplier):
+        """Records the position of a potential created in the core.
+
+        The core stores the potentials in the order of creation and the multipliers
+        of product potentials inside the potentials they multiply. 
+        :meth:`~pysic.calculator.Pysic.update_core_potentials` calls this method
+        after creating each potential, so that the parameters of the potentials 
+        can later be changed directly in the core. For each core potential, the
+        list ``core_potential_map`` gets a [potential, index, multiplier] entry
+        for the potential itself (with multiplier 0) and for its multipliers.
+
+        Parameters:
+
+        potential: :class:`~pysic.interactions.local.Potential` object
+            the potential that was created
+        is_multiplier: logical
+            True if the potential was added as a multiplier for the next potentials
+        """
+        if is_multiplier:
+            self.core_multipliers.append([potential, len(self.core_multipliers)+1])
+        else:
+            index = self.n_core_potentials
+            self.n_core_potentials += 1
+            self.core_potential_map.append([potential, index, 0])
+            for multiplier, slot in self.core_multipliers:
+                self.core_potential_map.append([multiplier, index, slot])
+
+
     def update_core_coulomb(self):
         """Updates the Coulomb summation parameters in the Fortran core.
             """
@@ -1479,9 +3115,48 @@ class Pysic:
                                                         epsilon,
                                                         scales)
 
-                Pysic.core.set_coulomb(self.coulomb)
+                Pysic.core.set_coulomb(self.coulomb, self.versions['coulomb'])
+
+            elif self.coulomb.method == CoulombSummation.summation_modes[1]: # particle mesh ewald summation
+                rcut = self.coulomb.parameters['real_cutoff']
+                order = int(self.coulomb.parameters['order'])
+                sigma = self.coulomb.parameters['sigma']
+                epsilon = self.coulomb.parameters['epsilon']
+                
+                scales = self.coulomb.get_scaling_factors()
+
+                # the grid size depends on the cell
+                grid = self.coulomb.get_pme_grid(self.structure.get_cell())
+                if order < 3:
+                    raise InvalidParametersError("The order of the B-splines in particle mesh Ewald summation must be at least 3.")
+
+                if scales == None:
+                    scales = [1.0]*self.structure.get_number_of_atoms()
+                elif(len(scales) != self.structure.get_number_of_atoms()):
+                    raise InvalidParametersError("Length of the scaling factor vector does not match the number of atoms.")
+                
+                pf.pysic_interface.set_pme_parameters(rcut,
+                                                      np.array(grid),
+                                                      order,
+                                                      sigma,
+                                                      epsilon,
+                                                      scales)
+
+                Pysic.core.set_coulomb(self.coulomb, self.versions['coulomb'])
         
     
+    def get_momentum_array(self):
+        """Returns the momenta of the structure in the calculator as a C-ordered (n_atoms, 3) array.
+
+        If the structure has momenta, the array is the one stored in the structure, not a copy.
+        Otherwise an array of zeros is returned.
+        """
+        if self.structure.has('momenta'):
+            return self.structure.arrays['momenta']
+        else:
+            return np.zeros([len(self.structure),3])
+
+
     def update_core_coordinates(self):
         """Updates the positions and momenta of atoms in the Fortran core.
 
@@ -1493,23 +3168,31 @@ class Pysic:
         if self.structure.get_number_of_atoms() != pf.pysic_interface.get_number_of_atoms():
             raise LockedCoreError("The number of atoms does not match.")
         
-        positions = np.array( self.structure.get_positions() ).transpose()
-        momenta = np.array( self.structure.get_momenta() ).transpose()
+        # The arrays of the structure are C-ordered (n_atoms, 3) arrays whose
+        # transposes are passed to the core without copying.
+        # The momenta are only sent if they have changed.
+        positions = self.structure.arrays['positions'].T
 
         self.forces = None
         self.energy = None
         self.stress = None
+        self.energies = None
+        self.virials = None
         self.electronegativities = None
 
-        pf.pysic_interface.update_atom_coordinates(positions,momenta)
+        if Pysic.core.is_current('momenta', self.versions['momenta']):
+            pf.pysic_interface.update_atom_positions(positions)
+        else:
+            pf.pysic_interface.update_atom_coordinates(positions,self.get_momentum_array().T)
 
-        Pysic.core.set_atomic_positions(self.structure)
-        Pysic.core.set_atomic_momenta(self.structure)
+        Pysic.core.set_atomic_positions(self.structure, self.versions['positions'])
+        Pysic.core.set_atomic_momenta(self.structure, self.versions['momenta'])
                 
         if not self.neighbor_lists_waiting:
             self.create_neighbor_lists(self.get_individual_cutoffs(1.0))
         
-        self.update_core_neighbor_lists()
+        if not self.update_core_neighbor_lists():
+            self.neighbor_list_reuses += 1
 
 
     def get_charges(self, system=None):
@@ -1540,6 +3223,8 @@ class Pysic:
         self.forces = None
         self.energy = None
         self.stress = None
+        self.energies = None
+        self.virials = None
         self.electronegativities = None
         
         total_charge = np.sum(charges)
@@ -1549,7 +3234,7 @@ class Pysic:
         pf.pysic_interface.update_atom_charges(charges)
         self.charges = charges
         
-        Pysic.core.set_charges(charges)
+        Pysic.core.set_charges(charges, self.versions['charges'])
             
             
     def update_core_supercell(self):
@@ -1560,36 +3245,43 @@ class Pysic:
         
         pf.pysic_interface.create_cell(vectors,inverse,periodicity)
         
-        Pysic.core.set_cell(self.structure)
+        Pysic.core.set_cell(self.structure, self.versions['cell'])
         Pysic.core.set_neighbor_lists(None)
             
 
     def update_core_neighbor_lists(self):
         """Updates the neighbor lists in the Fortran core.
 
-         If uninitialized, the lists are created first via :meth:`~pysic.calculator.Pysic.create_neighbor_lists`.
-         """
+        If uninitialized, the lists are created first via :meth:`~pysic.calculator.Pysic.create_neighbor_lists`.
+        The lists are only rebuilt if the atoms have moved too much
+        since the previous build, as decided by the ``update`` method of the list.
 
-        if not Pysic.core.atoms_ready(self.structure):
+        Returns True if the lists were rebuilt, False otherwise.
+        """
+
+        if not Pysic.core.is_current('positions', self.versions['positions']):
             raise MissingAtomsError("Creating neighbor lists before updating atoms in the core.")
-        cutoffs = self.get_individual_cutoffs(1.0)
 
         if not self.neighbor_lists_waiting:
+            cutoffs = self.get_individual_cutoffs(1.0)
             self.create_neighbor_lists(cutoffs)
             self.set_cutoffs(cutoffs)
             self.neighbor_lists_waiting = True
 
-        self.neighbor_list.update(self.structure)
-        if isinstance(self.neighbor_list,FastNeighborList):
-            # if we used the fast list, the core is already updated
-            pass
-        else:
+        rebuilt = self.neighbor_list.update(self.structure)
+        # if the lists were not rebuilt, the lists in the core are still valid, and
+        # if we used the fast list, the core is already updated
+        if rebuilt and not isinstance(self.neighbor_list,FastNeighborList):
             # if we have used the ASE list, it must be passed on to the core
             for index in range(self.structure.get_number_of_atoms()):
                 [nbors,offs] = self.neighbor_list.get_neighbors(index)                
                 pf.pysic_interface.create_neighbor_list(index+1,np.array(nbors),np.array(offs).transpose())
 
+        if rebuilt:
+            self.neighbor_list_rebuilds += 1
+
         Pysic.core.set_neighbor_lists(self.neighbor_list)
+        return rebuilt
 
 
     def initialize_fortran_core(self):
@@ -1605,15 +3297,11 @@ class Pysic:
             self.charges = np.array( self.structure.get_charges() )
         
         charges = self.charges
-        positions = np.array( self.structure.get_positions() ).transpose()
-        momenta = np.array( self.structure.get_momenta() ).transpose()
+        positions = self.structure.arrays['positions'].T
+        momenta = self.get_momentum_array().T
         tags = np.array( self.structure.get_tags() )
-        elements = self.structure.get_chemical_symbols()
-
-        for index in range(len(elements)):
-            elements[index] = pu.str2ints(elements[index],2)
 
-        elements = np.array( elements ).transpose()
+        elements = element_codes(self.structure.get_atomic_numbers())
 
         #self.create_neighbor_lists(self.get_individual_cutoffs(1.0))
         #self.neighbor_lists_waiting = True
@@ -1624,7 +3312,7 @@ class Pysic:
 
 
         pf.pysic_interface.create_atoms(masses,charges,positions,momenta,tags,elements)
-        Pysic.core.set_atoms(self.structure)
+        Pysic.core.set_atoms(self.structure, self.versions)
 
         pf.pysic_interface.distribute_mpi(self.structure.get_number_of_atoms())
         Pysic.core.mpi_ready = True
@@ -5,7 +5,7 @@ try:
     from scipy.optimize import fmin_slsqp
 except:
     print "scipy not found, slsqp charge optimization not available"
-from pysic.utility.error import InvalidRelaxationError
+from pysic.utility.error import InvalidRelaxationError, warn
 
 class ChargeRelaxation:
     """A class for handling charge dynamics and relaxation.
@@ -45,7 +45,7 @@ class ChargeRelaxation:
             updated as well, the relaxation algorithm must have access to it.
     """
 
-    relaxation_modes = [ 'dynamic', 'potentiostat', 'optimize' ]
+    relaxation_modes = [ 'dynamic', 'potentiostat', 'optimize', 'conjugate_gradient', 'extended_lagrangian' ]
     """Names of the charge relaxation algorithms available. 
         
         These are keywords needed when creating the 
@@ -53,7 +53,9 @@ class ChargeRelaxation:
     
     relaxation_parameters = { relaxation_modes[0] : ['n_steps', 'timestep', 'inertia', 'friction', 'tolerance'],
         relaxation_modes[1] : ['n_steps', 'timestep', 'inertia', 'potential'],
-        relaxation_modes[2] : ['n_steps', 'tolerance'] }
+        relaxation_modes[2] : ['n_steps', 'tolerance'],
+        relaxation_modes[3] : ['n_steps', 'tolerance'],
+        relaxation_modes[4] : ['n_corrections', 'dissipation_order', 'n_steps', 'tolerance'] }
     """Names of the parameters of the charge relaxation algorithms."""
     
     relaxation_parameter_descriptions = { relaxation_modes[0] : ['number of time steps of charge dynamics between molecular dynamics', 
@@ -66,8 +68,23 @@ class ChargeRelaxation:
             'fictional charge mass', 
             'external potential'],
         relaxation_modes[2] : ['maximum number of optimization steps',
+            'convergence tolerance'],
+        relaxation_modes[3] : ['maximum number of electronegativity evaluations',
+            'convergence tolerance'],
+        relaxation_modes[4] : ['number of conjugate gradient corrections per step',
+            'order of the dissipation in the propagation of auxiliary charges (3-7)',
+            'maximum number of electronegativity evaluations in the initial relaxation',
             'convergence tolerance'] }
     """Short descriptions of the relaxation parameters."""
+
+    dissipation_coefficients = { 3 : (1.69, 0.150, [-2, 3, 0, -1]),
+        4 : (1.75, 0.057, [-3, 6, -2, -2, 1]),
+        5 : (1.82, 0.018, [-6, 14, -8, -3, 4, -1]),
+        6 : (1.84, 0.0055, [-14, 36, -27, -2, 12, -6, 1]),
+        7 : (1.86, 0.0016, [-36, 99, -88, 11, 32, -25, 8, -1]) }
+    """Coefficients :math:`(\\kappa, \\alpha, [c_0, \\ldots, c_K])` for the dissipative propagation of the
+        auxiliary charges in the extended Lagrangian mode, given for each dissipation order :math:`K`.
+        (A.M.N. Niklasson et al., J. Chem. Phys. 130, 214109 (2009).)"""
     
     def __init__(self, relaxation='dynamic', calculator=None, parameters=None, atoms=None):
         self.set_relaxation(relaxation)
@@ -76,7 +93,9 @@ class ChargeRelaxation:
         self.set_atoms(atoms)
         self.piped_relaxation = None
         self.charge_rates = None
+        self.previous_charges = None
         self.observers = []
+        self.reset_extended_lagrangian()
 
     
     def __eq__(self,other):
@@ -372,25 +391,248 @@ class ChargeRelaxation:
     
     def _energy_function(self, charges, orig_charge):
 
-        try:
-            self.calculator.get_atoms().set_initial_charges(charges)
-        except:
-            self.calculator.get_atoms().set_charges(charges)
+        self.calculator.update_charges(charges)
 
         return self.calculator.get_potential_energy(skip_charge_relaxation=True)
     
     def _nabla_function(self, charges, orig_charge):
-    
-        try:
-            self.calculator.get_atoms().set_initial_charges(charges)
-        except:
-            self.calculator.get_atoms().set_charges(charges)
 
-        return -self.calculator.get_electronegativities()
+        return -self.calculator.get_electronegativities_for_charges(charges)
+
+    def _electronegativity_differences(self, charges):
+
+        enegs = self.calculator.get_electronegativities_for_charges(charges)
+        return enegs - enegs.sum()/len(enegs)
     
     def _charge_constraint(self, charges, orig_charge):
         return np.sum(charges) - orig_charge
 
+    def _hardness_diagonal(self, charges):
+        """Returns an estimate for the diagonal of the hardness matrix.
+
+        The diagonal is collected from the ``charge_self`` potentials
+        of the calculator,
+        :math:`\\partial^2 E / \\partial q_i^2 = \\varepsilon n (n-1) q_i^{n-2}`.
+        Other contributions, e.g., from Coulomb interactions, are ignored,
+        since the estimate is only used for preconditioning.
+        Non-positive values are replaced by the average of the positive ones
+        (or by 1, if there are none).
+
+        Parameters:
+
+        charges: numpy array of doubles
+            the atomic charges
+        """
+        atoms = self.calculator.get_atoms()
+        symbols = atoms.get_chemical_symbols()
+        tags = atoms.get_tags()
+        diagonal = np.zeros(len(atoms))
+
+        for pot in self.calculator.get_potentials():
+            if pot.get_potential_type() != 'charge_self' or pot.get_coordinator() is not None:
+                continue
+            epsilon = pot.get_parameter_value('epsilon')
+            n = int(pot.get_parameter_value('n'))
+            if n < 2:
+                continue
+            targets = np.zeros(len(atoms), dtype=bool)
+            if pot.get_symbols() is not None:
+                for target in pot.get_symbols():
+                    targets = np.logical_or(targets, [ symbol == target[0] for symbol in symbols ])
+            if pot.get_tags() is not None:
+                for target in pot.get_tags():
+                    targets = np.logical_or(targets, tags == target[0])
+            if pot.get_indices() is not None:
+                for target in pot.get_indices():
+                    targets[target[0]] = True
+            diagonal[targets] += epsilon * n * (n-1) * charges[targets]**(n-2)
+
+        positive = diagonal > 0.0
+        if positive.any():
+            diagonal[np.logical_not(positive)] = diagonal[positive].mean()
+        else:
+            diagonal[:] = 1.0
+        return diagonal
+
+    def _conjugate_gradient(self, charges, n_steps, tolerance):
+        """Solves the equilibrium charges by preconditioned conjugate gradients.
+
+        The method assumes the energy to be quadratic in the charges,
+        :math:`E = E_0 - \\chi_0 \\cdot q + \\frac{1}{2} q^T H q`,
+        so that the electronegativities are linear,
+        :math:`\\chi(q) = \\chi_0 - H q`. The hardness matrix :math:`H` is never
+        assembled. Instead, its product with a vector :math:`p` is obtained
+        from one electronegativity evaluation as
+        :math:`H p = \\chi(q) - \\chi(q+p)`.
+        The total charge is conserved by searching only in directions whose
+        components sum to zero, and the search directions are preconditioned
+        with the diagonal estimate given by :meth:`~pysic.charges.relaxation.ChargeRelaxation._hardness_diagonal`.
+
+        If the energy is not exactly quadratic, the residual is checked by
+        a direct evaluation whenever the iteration has converged and the iteration
+        is restarted from the new charges if necessary.
+
+        The relaxed charges are returned together with the largest
+        electronegativity difference remaining.
+
+        Parameters:
+
+        charges: numpy array of doubles
+            the starting charges
+        n_steps: integer
+            the maximum number of electronegativity evaluations
+        tolerance: double
+            the convergence tolerance for electronegativity differences
+        """
+
+        inv_diagonal = 1.0 / self._hardness_diagonal(charges)
+        inv_diagonal_sum = inv_diagonal.sum()
+        atoms = self.calculator.get_atoms()
+
+        enegs = self.calculator.get_electronegativities_for_charges(charges)
+        evaluations = 1
+        step = 0
+        restart = True
+        core_updated = True
+        
+        while True:
+
+            # the residual is the negative of the projected energy gradient
+            residual = enegs - enegs.sum()/len(enegs)
+            error = np.abs(residual).max()
+            if error < tolerance:
+                if restart or evaluations >= n_steps:
+                    break
+                # the charges have converged according to the iterated residual,
+                # check it directly
+                enegs = self.calculator.get_electronegativities_for_charges(charges)
+                evaluations += 1
+                restart = True
+                core_updated = True
+                continue
+            if evaluations >= n_steps:
+                break
+
+            # diagonal preconditioning within the constant charge subspace
+            precond = inv_diagonal * residual
+            precond -= inv_diagonal * (precond.sum() / inv_diagonal_sum)
+            rho = np.dot(residual, precond)
+
+            if restart:
+                direction = precond
+                restart = False
+            else:
+                direction = precond + (rho / rho_old) * direction
+            rho_old = rho
+
+            # H p = chi(q) - chi(q+p)
+            hardness_direction = enegs - self.calculator.get_electronegativities_for_charges(charges + direction)
+            evaluations += 1
+            core_updated = False
+            curvature = np.dot(direction, hardness_direction)
+            if curvature <= 0.0:
+                warn("The energy is not convex with respect to the charges, "+
+                     "conjugate gradient charge relaxation stopped.", 2)
+                break
+
+            alpha = rho / curvature
+            charges = charges + alpha * direction
+            enegs = enegs - alpha * hardness_direction
+
+            step += 1
+            if len(self.observers) > 0:
+                try:
+                    atoms.set_initial_charges(charges)
+                except:
+                    atoms.set_charges(charges)
+                self.call_observers(step)
+
+        # leave the core with the final charges
+        if not core_updated:
+            self.calculator.update_charges(charges)
+        return charges, error
+
+    def _extended_lagrangian_step(self, charges):
+        """Propagates the auxiliary charges and returns the corrected charges.
+
+        On the first call, or if the number of atoms has changed,
+        the charges are fully relaxed with :meth:`~pysic.charges.relaxation.ChargeRelaxation._conjugate_gradient`
+        and the history of auxiliary charges is initialized with the result.
+        Otherwise, the charges are obtained by correcting the current auxiliary charges
+        :math:`n_j` with ``n_corrections`` conjugate gradient iterations, and the auxiliary charges are
+        propagated with
+
+        .. math::
+
+            n_{j+1} = 2 n_j - n_{j-1} + \\kappa (q_j - n_j) + \\alpha \\sum_{k=0}^K c_k n_{j-k}.
+
+        Parameters:
+
+        charges: numpy array of doubles
+            the current charges
+        """
+        positions = self.calculator.get_atoms().get_positions()
+        history = self.auxiliary_charges
+
+        if history is not None and len(history[-1]) == len(charges):
+            if self.propagated_positions is not None and (self.propagated_positions == positions).all():
+                # the charges have already been propagated for this geometry
+                charges = self.extended_lagrangian_charges
+                if (self.calculator.get_charges() != charges).any():
+                    self.calculator.update_charges(charges)
+                return np.copy(charges)
+
+        if history is None or len(history[-1]) != len(charges):
+            charges, error = self._conjugate_gradient(charges,
+                                                      self.parameters['n_steps'],
+                                                      self.parameters['tolerance'])
+            order = int(self.parameters['dissipation_order'])
+            self.auxiliary_charges = [ np.copy(charges) for k in range(order+1) ]
+            self.charge_drift.append( (0.0, error) )
+        else:
+            kappa, alpha, coefficients = \
+                ChargeRelaxation.dissipation_coefficients[len(history)-1]
+            auxiliary = history[-1]
+            charges, error = self._conjugate_gradient(np.copy(auxiliary),
+                                                      1 + int(self.parameters['n_corrections']),
+                                                      self.parameters['tolerance'])
+
+            propagated = 2.0 * auxiliary - history[-2] + kappa * (charges - auxiliary)
+            for k in range(len(coefficients)):
+                propagated += alpha * coefficients[k] * history[-1-k]
+            self.auxiliary_charges = history[1:] + [propagated]
+
+            drift = np.sqrt( ((charges - auxiliary)**2).sum() / len(charges) )
+            self.charge_drift.append( (drift, error) )
+
+        self.propagated_positions = np.copy(positions)
+        self.extended_lagrangian_charges = np.copy(charges)
+        return charges
+
+    def reset_extended_lagrangian(self):
+        """Clears the history of auxiliary charges and the recorded drift.
+
+        The next relaxation in the extended Lagrangian mode starts with a full
+        relaxation of the charges. This should be done if the structure is changed
+        discontinuously, e.g., between two separate simulations.
+        """
+        self.auxiliary_charges = None
+        self.propagated_positions = None
+        self.extended_lagrangian_charges = None
+        self.charge_drift = []
+
+    def get_charge_drift(self):
+        """Returns the recorded drift of the extended Lagrangian charge propagation.
+
+        For every relaxation done in the extended Lagrangian mode, a pair
+        (rms(:math:`q_j - n_j`), max(:math:`|\\Delta \\chi_i|`)) is recorded, i.e., the root mean square difference
+        between the corrected and the auxiliary charges and the largest electronegativity difference
+        remaining after the correction. If the propagation is stable,
+        both should stay small and not grow during the simulation. The energy
+        conservation should be checked from the total energy of the simulation.
+        """
+        return np.array(self.charge_drift)
+
     def charge_relaxation(self):
         """Performs the charge relaxation.
 
@@ -430,19 +672,18 @@ class ChargeRelaxation:
             
             if self.charge_rates is None:
                 self.charge_rates = np.array( len(atoms)*[0.0] ) # starting "velocities" \dot{q}
-            charge_forces = self.calculator.get_electronegativity_differences(atoms)
+
+            # the geometry stays fixed during the relaxation, so only the charges are updated in the core
+            self.calculator.start_charge_updates()
+            charge_forces = self._electronegativity_differences(charges)
             
             while (error > tolerance and step < n_steps):
                 charges += self.charge_rates * dt + \
                            (charge_forces - friction * self.charge_rates) * inv_mq * dt2
                 self.charge_rates = (1.0 - 0.5 * friction * dt) * self.charge_rates + \
                             charge_forces * 0.5 * inv_mq * dt
-                try:
-                    atoms.set_initial_charges(charges)
-                except:
-                    atoms.set_charges(charges)
 
-                charge_forces = self.calculator.get_electronegativity_differences(atoms)
+                charge_forces = self._electronegativity_differences(charges)
                 self.charge_rates = future_friction * \
                             ( self.charge_rates + charge_forces * 0.5 * inv_mq * dt )
                 step += 1
@@ -462,18 +703,15 @@ class ChargeRelaxation:
 
             if self.charge_rates is None:
                 self.charge_rates = np.array( len(atoms)*[0.0] ) # starting "velocities" \dot{q}
-            charge_forces = self.calculator.get_electronegativities(atoms)-ext_potential
+
+            self.calculator.start_charge_updates()
+            charge_forces = self.calculator.get_electronegativities_for_charges(charges)-ext_potential
             
             while (step < n_steps):
                 charges += self.charge_rates * dt + charge_forces * inv_mq * dt2
                 self.charge_rates = self.charge_rates + charge_forces * 0.5 * inv_mq * dt
 
-                try:
-                    atoms.set_initial_charges(charges)
-                except:
-                    atoms.set_charges(charges)
-
-                charge_forces = self.calculator.get_electronegativities(atoms)-ext_potential
+                charge_forces = self.calculator.get_electronegativities_for_charges(charges)-ext_potential
             
                 self.charge_rates = self.charge_rates + charge_forces * 0.5 * inv_mq * dt
 
@@ -484,8 +722,34 @@ class ChargeRelaxation:
                 
             charge0 = charges
             orig_charge = np.sum(charges),
-            
+
+            self.calculator.start_charge_updates()
             charges = fmin_slsqp(self._energy_function, charge0, fprime=self._nabla_function, eqcons=[self._charge_constraint], acc=self.parameters['tolerance'], iter=self.parameters['n_steps'], args=orig_charge)
+
+        elif self.relaxation == ChargeRelaxation.relaxation_modes[3]: # conjugate gradient
+
+            # If the charges are not passed back to a structure, the charges in the calculator
+            # are reset every time it receives a new geometry. Then the relaxation is started
+            # from the result of the previous relaxation instead.
+            if self.atoms is None and self.previous_charges is not None:
+                if len(self.previous_charges) == len(charges) and \
+                        abs(np.sum(self.previous_charges) - np.sum(charges)) < 1.0e-8:
+                    charges = np.copy(self.previous_charges)
+
+            self.calculator.start_charge_updates()
+            charges, error = self._conjugate_gradient(charges,
+                                                      self.parameters['n_steps'],
+                                                      self.parameters['tolerance'])
+            self.previous_charges = np.copy(charges)
+
+        elif self.relaxation == ChargeRelaxation.relaxation_modes[4]: # extended Lagrangian
+
+            order = int(self.parameters['dissipation_order'])
+            if not order in ChargeRelaxation.dissipation_coefficients:
+                raise InvalidRelaxationError("The dissipation order must be between 3 and 7.")
+
+            self.calculator.start_charge_updates()
+            charges = self._extended_lagrangian_step(charges)
         
         else:
             pass
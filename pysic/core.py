@@ -4,8 +4,13 @@ import pysic.pysic_fortran as pf
 import pysic.utility.f2py as pu
 from pysic.charges.relaxation import ChargeRelaxation
 from pysic.interactions.coulomb import CoulombSummation
+from pysic.interactions.tables import Table
 import numpy as np
 import copy
+import itertools
+import hashlib
+import cPickle
+import cStringIO
 import atexit
 from pysic.utility.mpi import *
 
@@ -320,6 +325,41 @@ def names_of_parameters(potential_name):
     else:
         return []
 
+def discrete_parameters(potential_name):
+    """Tells which parameters of a potential or bond order factor are discrete.
+
+    Some parameters are used as integers or identifiers instead of continuous values,
+    such as the exponents of the 'bond_bend', 'charge_self' and 'charge_pair' potentials
+    and the ids of tabulated potentials and bond order factors. The energy does not
+    depend smoothly on these parameters, so they cannot be differentiated or fitted.
+
+    The result is given in the format of :meth:`~pysic.core.names_of_parameters`,
+    with True for the discrete parameters. 
+
+    Parameters:
+
+    potential_name: string
+        the name of the potential or bond order factor
+    """
+
+    if(is_potential(potential_name)):
+        return [ bool(pf.pysic_interface.discrete_parameter_of_potential(potential_name,i))
+                 for i in range(number_of_parameters(potential_name)) ]
+    
+    elif(is_bond_order_factor(potential_name)):
+        # the id is the first parameter of all tabulated bond order factors
+        tabulated = potential_name in ('table_bond', 'table_scale')
+        discrete = []
+        first = True
+        for n_params in number_of_parameters(potential_name):
+            discrete.append( [ tabulated and first and i == 0 for i in range(n_params) ] )
+            if n_params > 0:
+                first = False
+        return discrete
+
+    else:
+        return []
+
 def index_of_parameter(potential_name, parameter_name):
     """Tells the index of a parameter of a potential or bond order factor in the list of parameters the potential uses.
 
@@ -489,19 +529,41 @@ class CoreMirror:
     """A class representing the status of the core.
 
     Whenever data is being passed over to the core for calculation,
-    it should also be saved in the CoreMirror. This makes the CoreMirror
+    it should also be recorded in the CoreMirror. This makes the CoreMirror
     reflect the current status of the core. Then, when something needs to be
     calculated, the :class:`~pysic.calculator.Pysic` calculator can simply check that
     it contains the same system as the CoreMirror to ensure that the
     core operates on the correct data.
 
-    All data given to CoreMirror is saved as deep copies, i.e., not as
-    the objects themselves but objects with exactly the same contents.
-    This way if the original objects are modified, the ones in CoreMirror
-    are not. This is the proper way to work, since the Fortran core
-    obviously does not change without pushing the changes in the Python
-    side to the core first.
-
+    The CoreMirror does not copy the data. Instead, every piece of data
+    pushed to the core is recorded with a version stamp,
+    obtained from :meth:`~pysic.core.CoreMirror.new_version`.
+    A calculator draws a new stamp for every piece of data it changes
+    (the kinds of data are listed in :data:`~pysic.core.CoreMirror.tracked_data`)
+    and the core is up to date if the stamps recorded in the CoreMirror
+    match those of the calculator, see :meth:`~pysic.core.CoreMirror.is_current`.
+    Since the stamps are unique, checking the status of the core takes the same
+    time regardless of the size of the system.
+    Potentials and Coulomb summation algorithms, which may be
+    edited in place, are also recorded as fingerprints
+    (see :meth:`~pysic.core.CoreMirror.fingerprint`) so that changes in them
+    can be spotted without storing copies.
+
+    The tables of tabulated potentials and bond order factors are stored in the
+    core by their fingerprints (see :meth:`~pysic.core.CoreMirror.store_table`),
+    so that identical tables are stored only once and kept in the core
+    as long as they are used.
+
+    Structures packed in the core with :meth:`~pysic.calculator.Pysic.pack_batch`
+    are recorded as ``batch``, the data returned by that method, until another 
+    structure is given to the core. This way the batch can be evaluated again 
+    without packing it anew.
+
+    The structures given to the CoreMirror are stored as references, and
+    the identity of the stored objects is not used to tell if the core is current.
+    The :class:`~pysic.calculator.Pysic` calculator passes its own private
+    copy of the structure and may edit it in place, e.g., when positions or charges
+    are updated. Such changes are only recognized through the version stamps.
         
     Since exactly one CoreMirror should exist during the simulation, 
     deletion of the instance (which should happen at program termination automatically)
@@ -513,6 +575,11 @@ class CoreMirror:
 
     """
 
+    tracked_data = ['numbers', 'positions', 'momenta', 'charges', 'cell', 'potentials', 'coulomb']
+    """The kinds of data whose versions are tracked."""
+
+    version_counter = itertools.count(1)
+
     def __init__(self):
         self.structure = None
         self.potentials = None
@@ -522,11 +589,155 @@ class CoreMirror:
         self.potential_lists_ready = False
         self.bond_order_factor_lists_ready = False
         self.mpi_ready = False        
+        self.batch = None
+        self.versions = dict.fromkeys(CoreMirror.tracked_data)
+        self.neighbor_list_versions = None
+        self.tables = {}
+        self.used_tables = set()
 
     def __repr__(self):
         return "CoreMirror()"
 
 
+    @staticmethod
+    def new_version():
+        """Returns a new version stamp.
+
+        The stamps are unique integers, so data marked with a new stamp 
+        never matches anything already recorded in the CoreMirror.
+        """
+        return CoreMirror.version_counter.next()
+
+
+    @staticmethod
+    def fingerprint(data):
+        """Returns a fingerprint of the given data.
+
+        The fingerprint is a hash of the pickled data. Equal fingerprints
+        mean that the data has not been changed. If the data cannot be pickled,
+        None is returned. :class:`~pysic.interactions.tables.Table` objects
+        are represented by their own fingerprints instead of their values,
+        so that large tables need not be pickled.
+
+        Parameters:
+
+        data: any picklable object
+            the data to be fingerprinted
+        """
+        try:
+            stream = cStringIO.StringIO()
+            pickler = cPickle.Pickler(stream, 2)
+            pickler.persistent_id = CoreMirror.table_fingerprint
+            pickler.dump(data)
+            return hashlib.md5(stream.getvalue()).hexdigest()
+        except:
+            return None
+
+
+    @staticmethod
+    def table_fingerprint(data):
+        """Returns the fingerprint of a table or None for other data.
+
+        Used for pickling the tables by their fingerprints in :meth:`~pysic.core.CoreMirror.fingerprint`.
+
+        Parameters:
+
+        data: any object
+            the object being pickled
+        """
+        if isinstance(data, Table):
+            return data.get_fingerprint()
+        return None
+
+
+    def store_table(self, table):
+        """Stores a table in the core and returns its index.
+
+        The tables are identified by their fingerprints and a table is only
+        passed to the core if no identical table is stored there already. 
+        The table is marked as used until :meth:`~pysic.core.CoreMirror.release_unused_tables`
+        is called.
+
+        Parameters:
+
+        table: :class:`~pysic.interactions.tables.Table` object
+            the table to be stored
+        """
+        key = table.get_fingerprint()
+        if key not in self.tables:
+            taken = set(self.tables.values())
+            index = 0
+            while index in taken:
+                index += 1
+            # the transpose of a row major array can be passed to the core without copying
+            pf.pysic_interface.store_table(index, table.get_values().T)
+            self.tables[key] = index
+        self.used_tables.add(key)
+        return self.tables[key]
+
+
+    def mark_tables_unused(self):
+        """Marks all the tables stored in the core as unused.
+
+        This should be called before the potentials are recreated in the core.
+        """
+        self.used_tables = set()
+
+
+    def release_unused_tables(self):
+        """Releases the tables not marked as used from the core.
+
+        The tables are marked as used by :meth:`~pysic.core.CoreMirror.store_table`.
+        After the potentials have been recreated in the core, the tables not
+        used by them can be released.
+        """
+        for key in self.tables.keys():
+            if key not in self.used_tables:
+                pf.pysic_interface.remove_table(self.tables[key])
+                del self.tables[key]
+        self.used_tables = set()
+
+
+    def is_current(self, key, version):
+        """Checks if the given version of data is in the core.
+
+        True is returned if the recorded version of the data matches
+        the given one, False otherwise. Unknown versions (None) never match.
+
+        Parameters:
+
+        key: string
+            the kind of data, one of :data:`~pysic.core.CoreMirror.tracked_data`
+        version: integer
+            the version stamp of the data
+        """
+        return version is not None and self.versions[key] == version
+
+
+    def get_version(self, key):
+        """Returns the version stamp of the data in the core.
+
+        Parameters:
+
+        key: string
+            the kind of data, one of :data:`~pysic.core.CoreMirror.tracked_data`
+        """
+        return self.versions[key]
+
+
+    def set_version(self, key, version):
+        """Records the version stamp of the data in the core.
+
+        Parameters:
+
+        key: string
+            the kind of data, one of :data:`~pysic.core.CoreMirror.tracked_data`
+        version: integer
+            the version stamp of the data, None if unknown
+        """
+        self.versions[key] = version
+
+
     def get_atoms(self):
         """Returns the `ASE Atoms`_ structure stored in the CoreMirror.
         """
@@ -550,105 +761,140 @@ class CoreMirror:
         pf.pysic_interface.examine_bond_order_factors()
 
 
-    def set_atoms(self, atoms):
-        """Copies and stores the entire `ASE Atoms`_ instance.
+    def set_atoms(self, atoms, versions=None):
+        """Stores the entire `ASE Atoms`_ instance.
 
         Parameters:
 
         atoms: `ASE Atoms`_ object
-            atomic structure to be saved"""
-        self.structure = copy.deepcopy(atoms)
-        del self.structure.constraints
+            atomic structure to be saved
+        versions: dictionary
+            the version stamps of the structure, 'numbers', 'positions', 
+            'momenta', 'charges' and 'cell', as given by the calculator
+        """
+        self.structure = atoms
+        if versions is None:
+            versions = {}
+        for key in ['numbers', 'positions', 'momenta', 'charges', 'cell']:
+            self.versions[key] = versions.get(key)
+        self.neighbor_list_versions = None
         self.potential_lists_ready = False
+        self.batch = None
 
-    def set_charges(self, charges):
-        """Copies and stores the charges of atoms in the `ASE Atoms`_ instance.
+    def set_charges(self, charges, version=None):
+        """Stores the charges of atoms in the `ASE Atoms`_ instance.
             
             Parameters:
             
-            atoms: `ASE Atoms`_ object
-                atomic structure containing the positions to be saved.
+            charges: numpy array of doubles
+                the charges to be saved
+            version: integer
+                the version stamp of the charges
             """
         # the call for charges was changed between ASE 3.6 and 3.7
         try:
             self.structure.set_charges(charges)
         except:
             self.structure.set_initial_charges(charges)
+        self.versions['charges'] = version
 
 
-    def set_atomic_positions(self, atoms):
-        """Copies and stores the positions of atoms in the `ASE Atoms`_ instance.
+    def set_atomic_positions(self, atoms, version=None):
+        """Stores the `ASE Atoms`_ instance containing the positions of atoms in the core.
 
         Parameters:
 
         atoms: `ASE Atoms`_ object
             atomic structure containing the positions to be saved.
+        version: integer
+            the version stamp of the positions
         """
-        self.structure.set_positions(atoms.get_positions())
+        self.structure = atoms
+        self.versions['positions'] = version
         
-    def set_atomic_momenta(self, atoms):
-        """Copies and stores the momenta of atoms in the `ASE Atoms`_ instance.
+    def set_atomic_momenta(self, atoms, version=None):
+        """Stores the `ASE Atoms`_ instance containing the momenta of atoms in the core.
 
         Parameters:
 
         atoms: `ASE Atoms`_ object
             atomic structure containing the momenta to be saved.
+        version: integer
+            the version stamp of the momenta
         """
-        self.structure.set_momenta(atoms.get_momenta())
+        self.structure = atoms
+        self.versions['momenta'] = version
     
     
-    def set_cell(self, atoms):
-        """Copies and stores the supercell in the `ASE Atoms`_ instance.
+    def set_cell(self, atoms, version=None):
+        """Stores the `ASE Atoms`_ instance containing the supercell in the core.
 
         Parameters:
 
         atoms: `ASE Atoms`_ object
             atomic structure containing the supercell to be saved.
+        version: integer
+            the version stamp of the supercell
         """
-        self.structure.set_cell(atoms.get_cell())
-        self.structure.set_pbc(atoms.get_pbc())
+        self.structure = atoms
+        self.versions['cell'] = version
         
-    def set_potentials(self, potentials):
-        """Copies and stores :class:`~pysic.interactions.local.Potential` potentials.
+    def set_potentials(self, potentials, version=None):
+        """Stores a fingerprint of :class:`~pysic.interactions.local.Potential` potentials.
 
-        The :class:`~pysic.interactions.local.Potential` instances are copied as a whole,
+        The :class:`~pysic.interactions.local.Potential` instances are fingerprinted as a whole,
         so any possible :class:`~pysic.interactions.bondorder.Coordinator` and
-        :class:`~pysic.interactions.bondorder.BondOrderParameters` objects are also stored.
+        :class:`~pysic.interactions.bondorder.BondOrderParameters` objects are also included.
 
         Parameters:
 
-        atoms: list of :class:`~pysic.interactions.local.Potential` objects
+        potentials: list of :class:`~pysic.interactions.local.Potential` objects
             Potentials to be saved.
+        version: integer
+            the version stamp of the potentials
         """
-        self.potentials = copy.deepcopy(potentials)
+        self.potentials = CoreMirror.fingerprint(potentials)
+        self.versions['potentials'] = version
         self.potential_lists_ready = False
 
     def set_neighbor_lists(self, lists):
-        """Copies and stores the neighbor lists.
+        """Stores the neighbor lists.
+
+        The lists are stored as a reference along with the versions of the positions
+        and the supercell in the core. The lists are considered valid until either of
+        these changes.
 
         Parameters:
 
-        atoms: `ASE NeighborList`_ object
+        lists: `ASE NeighborList`_ object
             Neighbor lists to be saved.
         """
-        self.neighbor_lists = copy.deepcopy(lists)
+        self.neighbor_lists = lists
+        if lists is None:
+            self.neighbor_list_versions = None
+        else:
+            self.neighbor_list_versions = (self.versions['positions'], self.versions['cell'])
 
         
-    def set_coulomb(self,coulomb):
-        """Copies and stores the Coulomb summation algorithm.
+    def set_coulomb(self, coulomb, version=None):
+        """Stores a fingerprint of the Coulomb summation algorithm.
         
         Parameters:
             
         coulomb: :class:`~pysic.interactions.coulomb.CoulombSummation`
             Coulomb summation algorithm to be saved            
+        version: integer
+            the version stamp of the summation algorithm
             """
-        self.coulomb = copy.deepcopy(coulomb)
+        self.coulomb = CoreMirror.fingerprint(coulomb)
+        self.versions['coulomb'] = version
     
     
     def atoms_ready(self, atoms):
-        """Checks if the positions and momenta of the given atoms match those in the core.
+        """Checks if the positions of the given atoms match those in the core.
 
         True is returned if the structures match, False otherwise.
+        The momenta do not affect the calculations and they are not compared.
 
         Parameters:
 
@@ -663,10 +909,31 @@ class CoreMirror:
             return False
         if((self.structure.get_positions() != atoms.get_positions()).any()):
             return False
-        if((self.structure.get_momenta() != atoms.get_momenta()).any()):
-            return False
     
         return True
+
+    def composition_ready(self, atoms):
+        """Checks if the atomic numbers, tags and masses of the given atoms match those in the core.
+
+        True is returned if the compositions match, False otherwise.
+
+        Parameters:
+
+        atoms: `ASE Atoms`_ object
+            The atoms to be compared.
+        """
+        if self.structure is None:
+            return False
+        if(len(self.structure) != len(atoms)):
+            return False
+        if((self.structure.get_atomic_numbers() != atoms.get_atomic_numbers()).any()):
+            return False
+        if((self.structure.get_tags() != atoms.get_tags()).any()):
+            return False
+        if((self.structure.get_masses() != atoms.get_masses()).any()):
+            return False
+
+        return True
                         
     def charges_ready(self, atoms):
         """Checks if the charges of the given atoms match those in the core.
@@ -716,47 +983,46 @@ class CoreMirror:
         """Checks if the given potentials match those in the core.
 
         True is returned if the potentials match, False otherwise.
+        The potentials are compared through their fingerprints.
 
         Parameters:
 
-        atoms: list of :class:`~pysic.interactions.local.Potential` objects
+        pots: list of :class:`~pysic.interactions.local.Potential` objects
             The potentials to be compared.
         """
-        if self.potentials == None:
-            if pots == None:
-                return True
-            else:
-                return False
-        return (self.potentials == pots)
+        if self.potentials is None:
+            return False
+        return self.potentials == CoreMirror.fingerprint(pots)
 
     def neighbor_lists_ready(self, lists):
         """Checks if the given neighbor lists match those in the core.
 
-        True is returned if the structures match, False otherwise.
+        True is returned if the lists are the ones stored in the core and 
+        they have been checked to be valid for the positions and the supercell in the core,
+        False otherwise.
 
         Parameters:
 
-        atoms: `ASE NeighborList`_ object
+        lists: `ASE NeighborList`_ object
             The neighbor lists to be compared.
         """
-        if self.neighbor_lists == None:
+        if self.neighbor_lists is None or lists is not self.neighbor_lists:
             return False
-        return self.neighbor_lists == lists
-
-            
-            
+        if self.versions['positions'] is None or self.versions['cell'] is None:
+            return False
+        return self.neighbor_list_versions == (self.versions['positions'], self.versions['cell'])
 
             
     def coulomb_summation_ready(self,coulomb):
         """Checks if the given Coulomb summation matches that in the core.
             
             True is returned if the summation algorithms match, False otherwise.
+            The algorithms are compared through their fingerprints.
             
             Parameters: :class:`~pysic.interactions.coulomb.CoulombSummation`
                 the summation algorithm to be compared
             """
-        if self.coulomb == None:
+        if self.coulomb is None:
             return False
-        return self.coulomb == coulomb
-
+        return self.coulomb == CoreMirror.fingerprint(coulomb)
 
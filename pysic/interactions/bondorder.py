@@ -2,6 +2,7 @@
 
 from pysic.core import *
 from pysic.utility.error import InvalidParametersError, InvalidCoordinatorError, warn
+from pysic.interactions.tables import Table
 import pysic.pysic_fortran as pf
 
 class BondOrderParameters:
@@ -49,6 +50,7 @@ class BondOrderParameters:
         self.names_of_params = names_of_parameters(bond_order_type)
         self.n_params = number_of_parameters(bond_order_type)
         self.level = level_of_factor(bond_order_type)
+        self.table = None
 
         if parameters == None:
             self.parameters = 2*[[]]
@@ -80,6 +82,8 @@ class BondOrderParameters:
                 return False
             if self.symbols != other.symbols:
                 return False
+            if self.table != other.table:
+                return False
         except:
             return False
 
@@ -230,6 +234,33 @@ class BondOrderParameters:
         """Returns the keyword specifying the type of the bond order factor."""
         return self.bond_order_type
 
+    def get_table(self):
+        """Returns the :class:`~pysic.interactions.tables.Table` of a tabulated factor.
+
+        None is returned if no table has been given, in which case the table
+        is read from the file specified by the id parameter.
+        """
+        return self.table
+
+    def set_table(self,table):
+        """Gives the values of a tabulated bond order factor or scaling function directly.
+
+        Works as :meth:`~pysic.interactions.local.Potential.set_table` for tabulated potentials.
+
+        Parameters:
+
+        table: :class:`~pysic.interactions.tables.Table` object or an array of doubles
+            the table or an array of shape (n_values, 2) containing the values and scaled derivatives, 
+            None for reading the values from the file again
+        """
+        if self.bond_order_type not in ('table_bond', 'table_scale'):
+            raise InvalidParametersError("Only tabulated bond order factors accept tables, not '{bof}'.".
+                                         format(bof=self.bond_order_type))
+        if table is None or isinstance(table,Table):
+            self.table = table
+        else:
+            self.table = Table(table)
+
     def get_cutoff(self):
         """Returns the cutoff."""
         return self.cutoff
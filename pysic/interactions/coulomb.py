@@ -1,6 +1,8 @@
 #! /usr/bin/env python
 
 from pysic.utility.error import InvalidSummationError
+import numpy as np
+import math
 
 
 class CoulombSummation:
@@ -16,7 +18,12 @@ class CoulombSummation:
     the summations. Passing such an instance to the :class:`~pysic.calculator.Pysic`
     calculator activates the evaluation of Coulomb interactions.
     
-    Currently, only Ewald summation is available as a calculation method.
+    Two calculation methods are available: Ewald summation ('ewald'), where 
+    the reciprocal sum is evaluated directly over the k-vectors, and smooth particle mesh Ewald 
+    summation ('pme'), where the charges are interpolated on a grid and the reciprocal sum is 
+    evaluated using fast Fourier transforms. The cost of Ewald summation scales roughly as 
+    :math:`\mathcal{O}(N^{3/2})` at best while particle mesh Ewald scales as :math:`\mathcal{O}(N \log N)`,
+    so for large systems the latter is much faster.
         
     Parameters:
         
@@ -28,16 +35,26 @@ class CoulombSummation:
         numeric values for scaling the atomic charges in summation
     """
 
-    summation_modes = [ 'ewald' ]
+    summation_modes = [ 'ewald', 'pme' ]
     """Names of the summation methods. These are keywords used for setting up the summation algorithms."""
     summation_parameters = { summation_modes[0] : ['real_cutoff',
                                                    'k_cutoff',
                                                    'sigma',
+                                                   'epsilon'],
+                             summation_modes[1] : ['real_cutoff',
+                                                   'grid_spacing',
+                                                   'order',
+                                                   'sigma',
                                                    'epsilon'] }
     """Names of the parameters of the summation algorithm."""
     summation_parameter_descriptions = { summation_modes[0] : ['real space cutoff radius',
                                                    'reciprocal space cutoff radius',
                                                    'ewald summation split parameter',
+                                                   'vacuum permittivity'],
+                                         summation_modes[1] : ['real space cutoff radius',
+                                                   'maximum spacing of the charge grid',
+                                                   'order of the interpolating B-splines',
+                                                   'ewald summation split parameter',
                                                    'vacuum permittivity'] }
     """Short descriptions of the parameters of the summation algorithm."""
     
@@ -173,8 +190,54 @@ class CoulombSummation:
             """
         if self.method == CoulombSummation.summation_modes[0]: #ewald
             return self.parameters['real_cutoff']
+        elif self.method == CoulombSummation.summation_modes[1]: #pme
+            return self.parameters['real_cutoff']
         return 0.0
 
+    def get_pme_grid(self, cell):
+        """Returns the numbers of grid points along the cell vectors for particle mesh Ewald summation.
+
+        The grid is chosen so that the spacing between the grid planes is at most
+        the given 'grid_spacing' in each direction. The numbers of points are rounded up to
+        numbers with no prime factors larger than 5, since the fast Fourier transform
+        is fastest for such lengths. The grid always has at least as many points as the 
+        order of the B-splines in each direction.
+
+        Parameters:
+
+        cell: 3x3 array of doubles
+            the vectors spanning the simulation cell, as rows
+        """
+        cell = np.array(cell)
+        volume = abs(np.linalg.det(cell))
+        spacing = self.parameters['grid_spacing']
+        order = int(self.parameters['order'])
+        grid = []
+        for i in range(3):
+            # distance between the cell faces spanned by the other two vectors
+            height = volume / np.linalg.norm( np.cross( cell[(i+1)%3], cell[(i+2)%3] ) )
+            grid.append( fft_length( max( order, int( math.ceil( height / spacing - 1.0e-8 ) ) ) ) )
+        return grid
+
+
+def fft_length(minimum):
+    """Returns the smallest integer not smaller than the given minimum which only has prime factors 2, 3 and 5.
+
+    Parameters:
+
+    minimum: integer
+        the lower limit
+    """
+    length = max(minimum, 1)
+    while True:
+        remainder = length
+        for factor in (2, 3, 5):
+            while remainder % factor == 0:
+                remainder /= factor
+        if remainder == 1:
+            return length
+        length += 1
+
 
 def estimate_ewald_parameters(real_cutoff=10.0, accuracy='normal'):
     """Returns a tuple containing a good initial guess for Ewald parameters in the order `real_cutoff, k_cutoff, sigma, epsilon`.
@@ -216,3 +279,45 @@ def estimate_ewald_parameters(real_cutoff=10.0, accuracy='normal'):
         k_cutoff = 3.0/sigma
 
     return (real_cutoff, k_cutoff, sigma, epsilon)
+
+
+def estimate_pme_parameters(real_cutoff=10.0, accuracy='normal'):
+    """Returns a tuple containing a good initial guess for particle mesh Ewald parameters in the order `real_cutoff, grid_spacing, order, sigma, epsilon`.
+
+    The real space cutoff and sigma are chosen as in :meth:`~pysic.interactions.coulomb.estimate_ewald_parameters`,
+    and the grid is made dense enough to resolve the reciprocal sum up to
+    the k-space cutoff given by that function. The spacing of the grid and the order of
+    the B-splines are chosen so that the interpolation error does not exceed
+    the truncation error of Ewald summation with the same accuracy setting. 
+    Therefore both a denser grid and a higher order are used for higher accuracy.
+
+    The number of grid points along each cell vector is determined from the spacing
+    for the actual simulation cell when the summation is set up in the core,
+    see :meth:`~pysic.interactions.coulomb.CoulombSummation.get_pme_grid`.
+
+    Note that the given parameters are not analysed in any way - they are only a first guess.
+    You should always test the parameters for accuracy and speed before production simulations.
+
+    Parameters:
+
+    real_cutoff: double
+        the real space cutoff to be used - it should be shorter than the size of the simulation box
+    accuracy: string
+        either 'low', 'normal', 'high', 'real' or 'reciprocal'
+    """
+
+    real_cutoff, k_cutoff, sigma, epsilon = estimate_ewald_parameters(real_cutoff, accuracy)
+    if(accuracy == 'low'):
+        order = 4
+        resolution = 1.0
+    elif(accuracy == 'high'):
+        order = 6
+        resolution = 0.6
+    else:
+        order = 4
+        resolution = 0.6
+
+    # the grid resolves wave vectors up to pi/grid_spacing
+    grid_spacing = resolution * math.pi / k_cutoff
+
+    return (real_cutoff, grid_spacing, order, sigma, epsilon)
@@ -2,6 +2,7 @@
 
 from pysic.core import *
 from pysic.utility.error import InvalidPotentialError
+from pysic.interactions.tables import Table
 import copy
 
 class ProductPotential:
@@ -330,6 +331,7 @@ class Potential(object):
             self.cutoff = cutoff
             self.cutoff_margin = 0.0
             self.coordinator = None
+            self.table = None
             self.set_cutoff_margin(cutoff_margin)
             self.n_targets = number_of_targets(potential_type)
             self.names_of_params = names_of_parameters(potential_type)
@@ -369,6 +371,8 @@ class Potential(object):
                 return False         
             if self.coordinator != other.coordinator:
                 return False               
+            if self.table != other.table:
+                return False
         except:
             return False
         
@@ -526,6 +530,38 @@ class Potential(object):
         self.coordinator = coordinator
         
 
+    def get_table(self):
+        """Returns the :class:`~pysic.interactions.tables.Table` of a tabulated potential.
+
+        None is returned if no table has been given, in which case the table
+        is read from the file specified by the id parameter.
+        """
+        return self.table
+
+    def set_table(self,table):
+        """Gives the values of a tabulated potential directly.
+
+        Normally, the values of a tabulated potential are read from the file
+        specified by the id parameter (see :ref:`tabulated potential`). If a table is
+        given, the id is ignored and the values are taken from the table instead.
+        Identical tables are stored in the core only once, so the same values can be 
+        given to any number of potentials without duplicating them.
+
+        Parameters:
+
+        table: :class:`~pysic.interactions.tables.Table` object or an array of doubles
+            the table or an array of shape (n_values, 2) containing the values and scaled derivatives, 
+            None for reading the values from the file again
+        """
+        if self.potential_type != 'tabulated':
+            raise InvalidPotentialError("Only tabulated potentials accept tables, not '{pot}'.".
+                                        format(pot=self.potential_type))
+        if table is None or isinstance(table,Table):
+            self.table = table
+        else:
+            self.table = Table(table)
+
+
     def set_symbols(self,symbols):
         """Sets the list of symbols to equal the given list.
 
@@ -0,0 +1,148 @@
+#! /usr/bin/env python
+"""
+Tables of values for tabulated potentials and bond order factors.
+"""
+
+import os
+import hashlib
+import numpy as np
+from pysic.utility.error import InvalidParametersError
+
+table_prefix = 'table_'
+"""prefix of the names of numbered table files"""
+table_suffixes = ['.npy', '.txt']
+"""suffixes of the names of numbered table files, in the order of preference"""
+
+numbered_tables = {}
+"""tables read from numbered table files, stored by the file name"""
+
+
+class Table(object):
+    """A table of values for a tabulated potential or bond order factor.
+
+    The table contains the tabulated values and the derivatives multiplied
+    by the range of the tabulation in two columns, in the format of the table files
+    described in :ref:`tabulated potential`.
+
+    The values are not copied, so the table can be built on a memory-mapped
+    array, see :func:`~pysic.interactions.tables.load_table`.
+    When the table is given to the core, it is identified by a fingerprint
+    calculated from its contents, and identical tables are stored in the core only once.
+    Therefore the values must not be edited after creating the table.
+    Copying the table, also as a part of a potential, does not copy the values.
+
+    Parameters:
+
+    values: array of doubles
+        an array of shape (n_values, 2) containing the values and scaled derivatives
+    """
+
+    def __init__(self, values):
+        values = np.asarray(values, dtype=float)
+        if values.ndim != 2 or values.shape[1] != 2 or values.shape[0] < 2:
+            raise InvalidParametersError("A table must contain at least two rows of two values, not an array of shape "+
+                                         str(values.shape))
+        self.values = values
+        self.fingerprint = hashlib.sha1(np.ascontiguousarray(values)).hexdigest()
+
+    def __eq__(self, other):
+        try:
+            return self.fingerprint == other.fingerprint
+        except:
+            return False
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return "Table(<{n} values, fingerprint {f}>)".format(n=len(self.values), f=self.fingerprint)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def get_values(self):
+        """Returns the array of tabulated values.
+        """
+        return self.values
+
+    def get_number_of_values(self):
+        """Returns the number of tabulated values.
+        """
+        return len(self.values)
+
+    def get_fingerprint(self):
+        """Returns a fingerprint identifying the contents of the table.
+        """
+        return self.fingerprint
+
+    def save(self, filename):
+        """Writes the table in a file.
+
+        If the name of the file ends with '.npy', the table is written in the
+        binary format of numpy, which can be read back as a memory map.
+        Otherwise the table is written as text in the format of the table files.
+
+        Parameters:
+
+        filename: string
+            the name of the file
+        """
+        if filename.endswith('.npy'):
+            np.save(filename, self.values)
+        else:
+            np.savetxt(filename, self.values)
+
+
+def load_table(filename, memory_map=True):
+    """Reads a table from a file.
+
+    Files ending with '.npy' are read as binary numpy arrays,
+    by default as memory maps so that the values are read from the
+    disk only when needed. Other files are read as text files
+    of two columns as described in :ref:`tabulated potential`.
+
+    Parameters:
+
+    filename: string
+        the name of the file
+    memory_map: logical
+        if True, binary files are memory-mapped instead of read in memory
+    """
+    if filename.endswith('.npy'):
+        if memory_map:
+            return Table(np.load(filename, mmap_mode='r'))
+        else:
+            return Table(np.load(filename))
+    else:
+        return Table(np.loadtxt(filename, ndmin=2))
+
+
+def get_numbered_table(id):
+    """Returns the table of the given id.
+
+    Tabulated potentials and bond order factors without a :class:`~pysic.interactions.tables.Table`
+    read their values from the file ``table_xxxx.npy`` or ``table_xxxx.txt``, where ``xxxx`` is the
+    id with leading zeros. Each file is read only once and read again only if it is modified.
+    The binary files are memory-mapped.
+
+    Parameters:
+
+    id: integer
+        the identification number of the table
+    """
+    for suffix in table_suffixes:
+        filename = table_prefix+'{0:04d}'.format(id)+suffix
+        if os.path.isfile(filename):
+            break
+    else:
+        raise InvalidParametersError("No table file found for the id "+str(id))
+
+    status = os.stat(filename)
+    stamp = (status.st_mtime, status.st_size)
+    key = os.path.abspath(filename)
+    if key not in numbered_tables or numbered_tables[key][0] != stamp:
+        numbered_tables[key] = (stamp, load_table(filename))
+    return numbered_tables[key][1]
@@ -0,0 +1,497 @@
+#! /usr/bin/env python
+"""
+Tabulation of pair potentials as combined spline tables.
+"""
+
+import math
+from fractions import Fraction, gcd
+import numpy as np
+import pysic.pysic_fortran as pf
+from pysic.core import CoreMirror
+from pysic.interactions.local import Potential, ProductPotential
+from pysic.interactions.tables import Table, get_numbered_table
+from pysic.utility.error import InvalidParametersError, warn
+
+
+class PairTabulation:
+    """Class for combining pair potentials into tabulated potentials.
+
+    Most pair potentials are simple functions of the distance, but evaluating them
+    involves powers, exponentials and, for smooth cutoffs, cosines.
+    If several potentials act on the same pair of elements, all of these are
+    evaluated for every pair of atoms.
+    Passing an instance of this class to the :class:`~pysic.calculator.Pysic` calculator
+    with :meth:`~pysic.calculator.Pysic.set_pair_tabulation` makes the calculator
+    sum all such potentials acting on each pair of elements, including their smooth cutoffs,
+    and tabulate the sum in a single table for a 'tabulated' potential
+    (see :ref:`tabulated potential`). The core then interpolates one cubic spline
+    per pair of atoms instead of evaluating the potentials.
+
+    A potential is tabulated if it
+
+    - is a pair potential (or a product of pair potentials) of the types listed in
+      :data:`~pysic.interactions.tabulation.PairTabulation.tabulated_potentials`
+    - targets elements, not tags or indices
+    - has no :class:`~pysic.interactions.bondorder.Coordinator`
+
+    Other potentials are evaluated as usual. Potentials acting on the same pair of
+    elements are combined if they have the same cutoff, since the tables must
+    be continuous below their cutoff. The charge dependent potentials are never tabulated.
+
+    The tables span the distances from zero to the cutoff on an even grid.
+    The number of values is doubled, starting from about
+    :data:`~pysic.interactions.tabulation.PairTabulation.initial_intervals` intervals,
+    until the interpolated energies :math:`V` and derivatives :math:`dV/dr`
+    deviate from the potentials by less than the accuracy
+    :math:`\\epsilon` times :math:`1 + |V|` and :math:`1 + |dV/dr|`, respectively.
+    That is, the accuracy is an absolute tolerance (in eV and eV/Angstrom) for small values and a relative
+    one for large values.
+    The accuracy is only required above the minimum distance. Closer than that,
+    the tabulated energy continues linearly, so that the steep repulsive walls of
+    potentials do not need to be tabulated at very short distances where atoms never get.
+    If the accuracy is not reached with the maximum number of values, a warning is given.
+    The second derivatives of smooth cutoffs jump at the soft cutoffs, which splines
+    only follow if the jumps are at the tabulated points. Therefore the
+    number of intervals is chosen so that the soft cutoffs fall on the grid, if they divide
+    the cutoff in a simple ratio, such as 5:6.
+
+    Finally, the tables are validated by evaluating them through the core
+    at points different from those used in building them.
+    The results are available from :meth:`~pysic.interactions.tabulation.PairTabulation.get_report`.
+    The tables are rebuilt only when the tabulated potentials change.
+
+    Parameters:
+
+    accuracy: double
+        the target accuracy :math:`\\epsilon` of the tables
+    min_distance: double
+        the shortest distance where the accuracy is required
+    max_values: integer
+        the maximum number of values in a table
+    """
+
+    tabulated_potentials = [ 'LJ', 'spring', 'exponential', 'Buckingham',
+                             'power', 'shift_power', 'step', 'tabulated' ]
+    """Names of the potentials that can be tabulated. These depend only on the distance between the atoms."""
+    initial_intervals = 64
+    """The number of intervals in the first trial table."""
+    max_denominator = 64
+    """The largest number of intervals needed for placing a soft cutoff on the grid of an otherwise minimal table."""
+    validation_points = [ 0.125, 0.375, 0.625, 0.875 ]
+    """Relative positions of the validation points in the intervals of the final tables."""
+
+    def __init__(self, accuracy=1.0e-5, min_distance=1.0, max_values=2**20+1):
+        self.set_accuracy(accuracy)
+        self.set_min_distance(min_distance)
+        self.set_max_values(max_values)
+        self.tables = {}
+        self.report = []
+
+
+    def __eq__(self,other):
+        try:
+            if self.get_settings() != other.get_settings():
+                return False
+        except:
+            return False
+        return True
+
+
+    def __ne__(self,other):
+        return not self.__eq__(other)
+
+
+    def __repr__(self):
+        return "PairTabulation(accuracy={acc},min_distance={dist},max_values={n})".format(acc=str(self.accuracy),
+                                                                                          dist=str(self.min_distance),
+                                                                                          n=str(self.max_values))
+
+
+    def get_accuracy(self):
+        """Returns the target accuracy of the tables.
+        """
+        return self.accuracy
+
+
+    def get_min_distance(self):
+        """Returns the shortest distance where the accuracy is required.
+        """
+        return self.min_distance
+
+
+    def get_max_values(self):
+        """Returns the maximum number of values in a table.
+        """
+        return self.max_values
+
+
+    def get_settings(self):
+        """Returns the accuracy, the minimum distance and the maximum number of values as a tuple.
+        """
+        return (self.accuracy, self.min_distance, self.max_values)
+
+
+    def set_accuracy(self, accuracy):
+        """Sets the target accuracy of the tables.
+
+        Parameters:
+
+        accuracy: double
+            the target accuracy
+        """
+        if accuracy <= 0.0:
+            raise InvalidParametersError("The accuracy of the tables must be positive.")
+        self.accuracy = float(accuracy)
+
+
+    def set_min_distance(self, min_distance):
+        """Sets the shortest distance where the accuracy is required.
+
+        Parameters:
+
+        min_distance: double
+            the minimum distance
+        """
+        if min_distance <= 0.0:
+            raise InvalidParametersError("The minimum distance of the tables must be positive.")
+        self.min_distance = float(min_distance)
+
+
+    def set_max_values(self, max_values):
+        """Sets the maximum number of values in a table.
+
+        Parameters:
+
+        max_values: integer
+            the maximum number of values
+        """
+        if max_values < PairTabulation.initial_intervals+1:
+            raise InvalidParametersError("The tables must be allowed at least {n} values.".
+                                         format(n=PairTabulation.initial_intervals+1))
+        self.max_values = int(max_values)
+
+
+    def get_report(self):
+        """Returns the validation report of the tables built in the latest tabulation.
+
+        The report is a list containing a dictionary for each table with the keys
+
+        - 'symbols': the pair of elements
+        - 'cutoff': the cutoff of the tabulated potentials
+        - 'potentials': the number of potentials combined in the table
+        - 'values': the number of tabulated values
+        - 'spacing': the spacing of the tabulated values
+        - 'energy_error': the largest deviation of the energy from the potentials above the minimum distance
+        - 'force_error': the largest deviation of the derivative :math:`dV/dr` from the potentials above the minimum distance
+        - 'relative_error': the largest deviation of the energy or the derivative relative to :math:`1 + |V|` or :math:`1 + |dV/dr|`
+        - 'converged': True if the relative error is below the accuracy
+        """
+        return self.report
+
+
+    def accepts_potential(self, potential):
+        """Returns True if the potential can be tabulated, False otherwise.
+
+        Parameters:
+
+        potential: :class:`~pysic.interactions.local.Potential` object
+            the potential to be checked
+        """
+        if not isinstance(potential, (Potential, ProductPotential)):
+            return False
+        if potential.get_number_of_targets() != 2:
+            return False
+        if potential.get_coordinator() is not None:
+            return False
+        if potential.get_symbols() is None or \
+                potential.get_tags() is not None or \
+                potential.get_indices() is not None:
+            return False
+        if potential.get_cutoff() <= self.min_distance:
+            return False
+        for component in potential.get_potentials():
+            if component.get_potential_type() not in PairTabulation.tabulated_potentials:
+                return False
+        return True
+
+
+    def tabulate(self, potentials, core_parameters):
+        """Combines the pair potentials into tabulated potentials.
+
+        A list of potentials is returned, containing the potentials that are not
+        tabulated followed by a tabulated potential for each pair of elements and cutoff.
+        The tables of potentials that have not changed since the previous tabulation
+        are reused.
+
+        Parameters:
+
+        potentials: list of :class:`~pysic.interactions.local.Potential` objects
+            the potentials
+        core_parameters: function
+            a function returning the parameters of a potential in the form
+            given to the core, such as :meth:`~pysic.calculator.Pysic.get_core_parameters`
+        """
+        groups = {}
+        keys = []
+        untabulated = []
+        for pot in potentials:
+            if not self.accepts_potential(pot):
+                untabulated.append(pot)
+                continue
+            # each listed pair of elements is applied separately in the core,
+            # so a pair listed twice contributes twice also to the table
+            for symbols in pot.get_symbols():
+                key = tuple(sorted(symbols)) + (pot.get_cutoff(),)
+                if key not in groups:
+                    groups[key] = []
+                    keys.append(key)
+                groups[key].append(pot)
+
+        tables = {}
+        self.report = []
+        tabulated = []
+        for key in keys:
+            members = groups[key]
+            cutoff = key[2]
+            # the tables are reused if the potentials give the same values
+            description = []
+            for pot in members:
+                for comp in pot.get_potentials():
+                    table = comp.get_table()
+                    if table is None and comp.get_potential_type() == 'tabulated':
+                        table = get_numbered_table(int(comp.get_parameter_values()[0]))
+                    description.append([comp.get_potential_type(), comp.get_parameter_values(), table])
+                description.append(pot.get_soft_cutoff())
+            fingerprint = CoreMirror.fingerprint([cutoff, description, self.get_settings()])
+            if fingerprint is not None and fingerprint in self.tables:
+                table, stats = self.tables[fingerprint]
+            else:
+                table, stats = self.tabulate_pair(members, cutoff, core_parameters)
+            if fingerprint is not None:
+                tables[fingerprint] = [table, stats]
+
+            pot = Potential('tabulated',
+                            symbols=[list(key[:2])],
+                            parameters=[0, cutoff, 1.0],
+                            cutoff=cutoff)
+            pot.set_table(table)
+            tabulated.append(pot)
+            stats = dict(stats)
+            stats['symbols'] = list(key[:2])
+            self.report.append(stats)
+
+        self.tables = tables
+        return untabulated + tabulated
+
+
+    def tabulate_pair(self, potentials, cutoff, core_parameters):
+        """Builds the table of the sum of the given pair potentials.
+
+        The table and its validation statistics (see :meth:`~pysic.interactions.tabulation.PairTabulation.get_report`)
+        are returned.
+
+        Parameters:
+
+        potentials: list of :class:`~pysic.interactions.local.Potential` objects
+            the potentials acting on the pair of elements
+        cutoff: double
+            the cutoff of the potentials
+        core_parameters: function
+            a function returning the parameters of a potential in the form given to the core
+        """
+        min_distance = self.min_distance
+        quarters = np.array([0.25, 0.5, 0.75])
+        n_intervals = self.get_initial_intervals(potentials, cutoff)
+        while True:
+            spacing = cutoff / n_intervals
+            grid = spacing * np.arange(n_intervals+1)
+            # the intervals overlapping the accurate range
+            first = int(math.floor(min_distance / spacing))
+            energies, derivatives = self.get_tabulated_values(potentials, cutoff, core_parameters,
+                                                              grid, max(first,1))
+
+            points = ((np.arange(first, n_intervals)[:,np.newaxis] + quarters) * spacing).ravel()
+            points = points[points >= min_distance]
+            exact = self.evaluate_potentials(potentials, cutoff, core_parameters, points)
+            interpolated = self.interpolate(energies, derivatives, spacing, points)
+            error = self.get_relative_error(exact, interpolated)
+            if error <= self.accuracy or 2*n_intervals+1 > self.max_values:
+                break
+            n_intervals *= 2
+
+        table = Table(np.column_stack([energies, derivatives * cutoff]))
+
+        # validate the table by evaluating it through the core
+        tabulated = Potential('tabulated', parameters=[0, cutoff, 1.0], cutoff=cutoff)
+        tabulated.set_table(table)
+        points = ((np.arange(first, n_intervals)[:,np.newaxis] +
+                   PairTabulation.validation_points) * spacing).ravel()
+        points = points[points >= min_distance]
+        exact = self.evaluate_potentials(potentials, cutoff, core_parameters, points)
+        interpolated = self.evaluate_potentials([tabulated], cutoff, core_parameters, points)
+        error = self.get_relative_error(exact, interpolated)
+
+        stats = {'cutoff': cutoff,
+                 'potentials': len(potentials),
+                 'values': n_intervals+1,
+                 'spacing': spacing,
+                 'energy_error': 0.0,
+                 'force_error': 0.0,
+                 'relative_error': error,
+                 'converged': error <= self.accuracy}
+        if len(points) > 0:
+            stats['energy_error'] = np.max(np.abs(interpolated[0]-exact[0]))
+            stats['force_error'] = np.max(np.abs(interpolated[1]-exact[1]))
+        if not stats['converged']:
+            warn("The tabulated pair potentials reach the relative accuracy {err} instead of {acc} "
+                 "with {n} values:\n\n".format(err=error, acc=self.accuracy, n=n_intervals+1)+
+                 "\n".join([str(pot) for pot in potentials]), 2)
+        return table, stats
+
+
+    def get_initial_intervals(self, potentials, cutoff):
+        """Returns the number of intervals in the first trial table of the given potentials.
+
+        The number is chosen so that the soft cutoffs of the potentials are on the grid
+        also after doubling the number, if possible.
+
+        Parameters:
+
+        potentials: list of :class:`~pysic.interactions.local.Potential` objects
+            the potentials acting on the pair of elements
+        cutoff: double
+            the cutoff of the potentials
+        """
+        base = 1
+        for pot in potentials:
+            ratio = pot.get_soft_cutoff() / cutoff
+            fraction = Fraction(ratio).limit_denominator(PairTabulation.max_denominator)
+            if abs(float(fraction) - ratio) < 1.0e-10:
+                multiple = base * fraction.denominator / gcd(base, fraction.denominator)
+                if multiple <= PairTabulation.max_denominator:
+                    base = multiple
+        n_intervals = base
+        while n_intervals < PairTabulation.initial_intervals:
+            n_intervals *= 2
+        if n_intervals+1 > self.max_values:
+            n_intervals = PairTabulation.initial_intervals
+        return n_intervals
+
+
+    def get_tabulated_values(self, potentials, cutoff, core_parameters, grid, first):
+        """Returns the energies and derivatives to be tabulated on the given grid.
+
+        The potentials are evaluated at the grid points starting from the given one.
+        At the points before it, the energy is continued linearly.
+
+        Parameters:
+
+        potentials: list of :class:`~pysic.interactions.local.Potential` objects
+            the potentials acting on the pair of elements
+        cutoff: double
+            the cutoff of the potentials
+        core_parameters: function
+            a function returning the parameters of a potential in the form given to the core
+        grid: array of doubles
+            the distances of the tabulated values
+        first: integer
+            the index of the first grid point where the potentials are evaluated
+        """
+        energies = np.empty(len(grid))
+        derivatives = np.empty(len(grid))
+        energies[first:], derivatives[first:] = self.evaluate_potentials(potentials, cutoff, core_parameters,
+                                                                         grid[first:])
+        derivatives[:first] = derivatives[first]
+        energies[:first] = energies[first] + derivatives[first]*(grid[:first]-grid[first])
+        return energies, derivatives
+
+
+    def evaluate_potentials(self, potentials, cutoff, core_parameters, distances):
+        """Returns the summed energies and derivatives of the potentials at the given distances.
+
+        The potentials are evaluated in the core with the same kernels used in the calculations,
+        including the smooth cutoffs.
+
+        Parameters:
+
+        potentials: list of :class:`~pysic.interactions.local.Potential` objects
+            the potentials acting on the pair of elements
+        cutoff: double
+            the cutoff of the potentials
+        core_parameters: function
+            a function returning the parameters of a potential in the form given to the core
+        distances: array of doubles
+            the distances where the potentials are evaluated
+        """
+        total_energies = np.zeros(len(distances))
+        total_derivatives = np.zeros(len(distances))
+        if len(distances) == 0:
+            return total_energies, total_derivatives
+        for pot in potentials:
+            energies = np.ones(len(distances))
+            derivatives = np.zeros(len(distances))
+            # the smooth cutoff multiplies the whole product, so it is applied on the first component only
+            soft_cutoff = pot.get_soft_cutoff()
+            for component in pot.get_potentials():
+                comp_energies, comp_derivatives, success = \
+                    pf.pysic_interface.evaluate_pair_potential(component.get_potential_type(),
+                                                               core_parameters(component),
+                                                               cutoff,
+                                                               soft_cutoff,
+                                                               distances)
+                if not success:
+                    raise InvalidParametersError("Failed to evaluate a potential in the core: "+str(component))
+                derivatives = derivatives*comp_energies + energies*comp_derivatives
+                energies = energies*comp_energies
+                soft_cutoff = cutoff
+            total_energies += energies
+            total_derivatives += derivatives
+        return total_energies, total_derivatives
+
+
+    def interpolate(self, energies, derivatives, spacing, distances):
+        """Returns the energies and derivatives interpolated from tabulated values.
+
+        The interpolation is the cubic Hermite spline used by the tabulated potential in the core.
+
+        Parameters:
+
+        energies: array of doubles
+            the tabulated energies
+        derivatives: array of doubles
+            the tabulated derivatives
+        spacing: double
+            the spacing of the tabulated values
+        distances: array of doubles
+            the distances where the values are interpolated
+        """
+        lower = np.minimum(np.floor(distances / spacing).astype(int), len(energies)-2)
+        t = distances / spacing - lower
+        t2 = t*t
+        t3 = t2*t
+        interpolated_energies = energies[lower] * (2*t3 - 3*t2 + 1) + \
+            derivatives[lower]*spacing * (t3 - 2*t2 + t) + \
+            energies[lower+1] * (3*t2 - 2*t3) + \
+            derivatives[lower+1]*spacing * (t3 - t2)
+        interpolated_derivatives = energies[lower]/spacing * 6*(t2 - t) + \
+            derivatives[lower] * (3*t2 - 4*t + 1) + \
+            energies[lower+1]/spacing * 6*(t - t2) + \
+            derivatives[lower+1] * (3*t2 - 2*t)
+        return interpolated_energies, interpolated_derivatives
+
+
+    def get_relative_error(self, exact, interpolated):
+        """Returns the largest deviation of the interpolated values relative to :math:`1 + |V|`.
+
+        Parameters:
+
+        exact: tuple of arrays of doubles
+            the energies and derivatives of the potentials
+        interpolated: tuple of arrays of doubles
+            the interpolated energies and derivatives
+        """
+        error = 0.0
+        for values, approximations in zip(exact, interpolated):
+            if len(values) > 0:
+                error = max(error, np.max(np.abs(approximations-values) / (1.0 + np.abs(values))))
+        return error
@@ -0,0 +1,290 @@
+#! /usr/bin/env python
+"""
+Fitting of potential parameters to reference energies, forces and stresses.
+"""
+
+try:
+    from scipy.optimize import minimize
+except:
+    print "scipy not found, parameter fitting not available"
+import numpy as np
+from pysic.utility.error import InvalidParametersError
+
+
+class ParameterFit:
+    """A class for fitting the parameters of potentials to a training set.
+
+    The training set consists of structures and their reference energies, forces
+    and stresses. The fit minimizes the weighted sum of squared errors
+
+    .. math::
+
+        L = w_E \\sum_s (E_s - E_s^\\mathrm{ref})^2
+          + w_F \\sum_{i,\\alpha} (F_{i\\alpha} - F_{i\\alpha}^\\mathrm{ref})^2
+          + w_\\sigma \\sum_{s,k} (\\sigma_{sk} - \\sigma_{sk}^\\mathrm{ref})^2
+
+    where only the properties with given reference values are included.
+    The structures are packed in the core once as in
+    :meth:`~pysic.calculator.Pysic.evaluate_batch` and for each evaluation
+    only the parameter values are replaced in the core as in
+    :meth:`~pysic.calculator.Pysic.evaluate_parameter_sweep`.
+    The gradient of the loss is assembled from the derivatives of the free 
+    parameters given by :meth:`~pysic.calculator.Pysic.calculate_parameter_gradients`,
+    so the limitations of those methods apply.
+
+    The parameters are numbered in the order of the potentials and
+    :meth:`~pysic.interactions.local.Potential.get_parameter_values` for each potential,
+    followed by the bond order factors and
+    :meth:`~pysic.interactions.bondorder.BondOrderParameters.get_parameters_as_list` for each factor.
+    Discrete parameters, such as the exponents of some potentials and the ids of tables
+    (see :meth:`~pysic.core.discrete_parameters`), cannot be fitted and are kept fixed.
+
+    Parameters:
+
+    calculator: :class:`~pysic.calculator.Pysic` object
+        the calculator using the potentials
+    structures: list of `ASE Atoms`_ objects
+        the training structures
+    potentials: list of :class:`~pysic.interactions.local.Potential` objects
+        the potentials whose parameters are fitted
+    bond_order_parameters: list of :class:`~pysic.interactions.bondorder.BondOrderParameters` objects
+        the bond order factors whose parameters are fitted
+    energies: array of doubles
+        reference potential energies of the structures
+    forces: list of arrays of doubles
+        reference forces of the structures, one array of shape (n_atoms, 3) per structure
+    stresses: array of doubles
+        reference stresses of the structures in an array of shape (n_structures, 6)
+    energy_weight: double
+        the weight of the energy errors
+    force_weight: double
+        the weight of the force errors
+    stress_weight: double
+        the weight of the stress errors
+    free: list of logicals
+        True for the parameters to be fitted, by default all parameters except the discrete ones are fitted
+    """
+    def __init__(self, calculator, structures, potentials, bond_order_parameters=None,
+                 energies=None, forces=None, stresses=None,
+                 energy_weight=1.0, force_weight=1.0, stress_weight=1.0, free=None):
+        self.calculator = calculator
+        self.structures = structures
+        self.potentials = potentials
+        if bond_order_parameters is None:
+            self.bond_order_parameters = []
+        else:
+            self.bond_order_parameters = bond_order_parameters
+        self.energy_weight = energy_weight
+        self.force_weight = force_weight
+        self.stress_weight = stress_weight
+
+        n_structures = len(structures)
+        n_atoms = sum( [ len(structure) for structure in structures ] )
+        self.energies = None
+        self.forces = None
+        self.stresses = None
+        if energies is not None:
+            self.energies = np.array(energies, dtype=float)
+            if self.energies.shape != (n_structures,):
+                raise InvalidParametersError("One reference energy per structure is needed.")
+        if forces is not None:
+            self.forces = np.concatenate( [ np.reshape(f, [-1,3]) for f in forces ] ).astype(float)
+            if len(self.forces) != n_atoms:
+                raise InvalidParametersError("One reference force per atom is needed.")
+        if stresses is not None:
+            self.stresses = np.array(stresses, dtype=float)
+            if self.stresses.shape != (n_structures,6):
+                raise InvalidParametersError("One reference stress per structure is needed.")
+
+        discrete = calculator.get_discrete_parameters(self.potentials, self.bond_order_parameters)
+        n_params = len(discrete)
+        if free is None:
+            self.free = np.logical_not(discrete)
+        else:
+            self.free = np.array(free, dtype=bool)
+            if len(self.free) != n_params:
+                raise InvalidParametersError("The potentials have {n} parameters, not {m}.".
+                                             format(n=n_params, m=len(self.free)))
+            if np.any(self.free & discrete):
+                raise InvalidParametersError("Discrete parameters cannot be fitted: {p}".
+                                             format(p=list(np.nonzero(self.free & discrete)[0])))
+
+        self.batch = None
+        self.targets = None
+        self.bond_targets = None
+        self.update_core()
+
+
+    def get_parameters(self):
+        """Returns the current values of all the parameters as a single array.
+        """
+        values = []
+        for pot in self.potentials:
+            values += list(pot.get_parameter_values())
+        for bond in self.bond_order_parameters:
+            values += list(bond.get_parameters_as_list())
+        return np.array(values, dtype=float)
+
+
+    def set_parameters(self, values):
+        """Sets the values of all the parameters.
+
+        Parameters:
+
+        values: array of doubles
+            the parameters in the order of :meth:`~pysic.utility.fitting.ParameterFit.get_parameters`
+        """
+        first = 0
+        for pot in self.potentials:
+            last = first + pot.get_number_of_parameters()
+            pot.set_parameter_values(list(values[first:last]))
+            first = last
+        for bond in self.bond_order_parameters:
+            nested = []
+            for n_params in bond.get_number_of_parameters():
+                nested.append(list(values[first:first+n_params]))
+                first += n_params
+            bond.set_parameters(nested)
+
+
+    def get_free_parameters(self):
+        """Returns the current values of the fitted parameters.
+        """
+        return self.get_parameters()[self.free]
+
+
+    def set_free_parameters(self, values):
+        """Sets the values of the fitted parameters.
+
+        Parameters:
+
+        values: array of doubles
+            the fitted parameters in the order of :meth:`~pysic.utility.fitting.ParameterFit.get_parameters`
+        """
+        all_values = self.get_parameters()
+        all_values[self.free] = values
+        self.set_parameters(all_values)
+
+
+    def update_core(self):
+        """Passes the current parameters of the potentials and bond order factors to the core.
+
+        The training structures are packed in the core only if they are not there already,
+        i.e., on the first call or if the core has been used for other structures
+        in between. Otherwise only the parameter values are replaced in the core.
+        """
+        calc = self.calculator
+        if self.batch is None or calc.core.batch is not self.batch:
+            self.batch = calc.pack_batch(self.structures)
+            self.targets = calc.get_core_potential_targets(self.potentials)
+            self.bond_targets = calc.get_core_bond_order_targets(self.bond_order_parameters)
+        else:
+            for pot, targets in zip(self.potentials, self.targets):
+                calc.set_core_potential_parameters(pot, targets, pot.get_parameter_values())
+            for bond, bond_indices in zip(self.bond_order_parameters, self.bond_targets):
+                calc.set_core_bond_order_parameters(bond_indices, calc.get_core_parameters(bond))
+        # the core no longer holds the parameters the calculator has recorded
+        calc.core.set_potentials(None)
+
+
+    def get_loss(self, values=None):
+        """Returns the weighted sum of squared errors.
+
+        Parameters:
+
+        values: array of doubles
+            if given, the fitted parameters are first set to these values
+        """
+        if values is not None:
+            self.set_free_parameters(values)
+        self.update_core()
+        energies, forces, stresses = self.calculator.calculate_batch(self.batch)
+        loss, e_error, f_error, s_error = self.get_errors(energies, forces, stresses)
+        return loss
+
+
+    def get_loss_and_gradient(self, values=None):
+        """Returns the weighted sum of squared errors and its gradient with respect to the fitted parameters.
+
+        Parameters:
+
+        values: array of doubles
+            if given, the fitted parameters are first set to these values
+        """
+        if values is not None:
+            self.set_free_parameters(values)
+        calc = self.calculator
+        self.update_core()
+        energies, forces, stresses = calc.calculate_batch(self.batch)
+        d_energies, d_forces, d_stresses = calc.calculate_parameter_gradients(self.batch,
+                                                                             self.potentials,
+                                                                             self.bond_order_parameters,
+                                                                             self.free)
+        loss, e_error, f_error, s_error = self.get_errors(energies, forces, stresses)
+
+        gradient = np.zeros(len(d_energies))
+        if e_error is not None:
+            gradient += 2.0 * self.energy_weight * np.dot(d_energies, e_error)
+        if f_error is not None:
+            gradient += 2.0 * self.force_weight * np.dot(d_forces.reshape(len(gradient),-1), f_error.ravel())
+        if s_error is not None:
+            gradient += 2.0 * self.stress_weight * np.dot(d_stresses.reshape(len(gradient),-1), s_error.ravel())
+
+        return loss, gradient
+
+
+    def get_errors(self, energies, forces, stresses):
+        """Returns the loss and the deviations from the reference values.
+
+        Four values are returned: the loss and the deviations of the energies, forces and stresses.
+        The deviations of properties without reference values are None.
+
+        Parameters:
+
+        energies: array of doubles
+            the calculated energies of the structures
+        forces: array of doubles
+            the calculated forces on the atoms of all the structures
+        stresses: array of doubles
+            the calculated stresses of the structures
+        """
+        loss = 0.0
+        e_error = None
+        f_error = None
+        s_error = None
+        if self.energies is not None:
+            e_error = energies - self.energies
+            loss += self.energy_weight * np.dot(e_error, e_error)
+        if self.forces is not None:
+            f_error = forces - self.forces
+            loss += self.force_weight * np.dot(f_error.ravel(), f_error.ravel())
+        if self.stresses is not None:
+            s_error = stresses - self.stresses
+            loss += self.stress_weight * np.dot(s_error.ravel(), s_error.ravel())
+        return loss, e_error, f_error, s_error
+
+
+    def fit(self, method='L-BFGS-B', bounds=None, options=None):
+        """Minimizes the loss with respect to the fitted parameters.
+
+        The minimization is done with scipy.optimize.minimize using the
+        analytic gradient. The parameters of the potentials are left at the
+        optimized values and the result of the minimization is returned.
+
+        Parameters:
+
+        method: string
+            a gradient based minimization method of scipy.optimize.minimize
+        bounds: list of pairs of doubles
+            (min, max) bounds for the fitted parameters, if supported by the method
+        options: dictionary
+            options passed to the minimizer
+        """
+        result = minimize(self.get_loss_and_gradient,
+                          self.get_free_parameters(),
+                          method=method,
+                          jac=True,
+                          bounds=bounds,
+                          options=options)
+        self.set_free_parameters(result.x)
+        return result
@@ -46,6 +46,77 @@ class BondType:
 
 
 
+class Observations(object):
+    """A set of angles or distances stored as typed columns.
+
+    Instead of one :class:`~pysic.utility.outliers.Angle` or 
+    :class:`~pysic.utility.outliers.Distance` object per observation,
+    the observations are stored as three arrays of equal length:
+    ``centers`` contains the index of the central (primary) atom,
+    ``labels`` the index of the label (such as 'O-Si-Si') in the list ``label_names``,
+    and ``values`` the observed angle or distance.
+
+    The observations of several structures, e.g., the frames of a trajectory, 
+    can be combined with :meth:`~pysic.utility.outliers.Observations.concatenate`.
+    """
+
+    def __init__(self, centers, labels, values, label_names):
+        self.centers     = np.asarray(centers, dtype=np.int32)
+        self.labels      = np.asarray(labels, dtype=np.int32)
+        self.values      = np.asarray(values, dtype=float)
+        self.label_names = list(label_names)
+
+    def __len__(self):
+        return len(self.values)
+
+    @staticmethod
+    def concatenate(observation_sets):
+        """Returns the observations of several sets combined in one set.
+
+        The labels are matched by their names, so the sets may contain different labels.
+        The atom indices are not changed.
+        """
+        names = sorted(set(name for obs in observation_sets for name in obs.label_names))
+        index_of = dict( (name, index) for index, name in enumerate(names) )
+        centers = [np.zeros(0, dtype=np.int32)]
+        labels  = [np.zeros(0, dtype=np.int32)]
+        values  = [np.zeros(0)]
+        for obs in observation_sets:
+            mapping = np.array([index_of[name] for name in obs.label_names], dtype=np.int32)
+            centers.append(obs.centers)
+            labels.append(mapping[obs.labels])
+            values.append(obs.values)
+        return Observations(np.concatenate(centers),
+                            np.concatenate(labels),
+                            np.concatenate(values),
+                            names)
+
+    @staticmethod
+    def from_angles(angles):
+        """Returns the observations contained in a list of Angle objects.
+        """
+        names  = [a.type1 + '-' + a.type2 + '-' + a.type3 for a in angles]
+        unique = sorted(set(names))
+        index_of = dict( (name, index) for index, name in enumerate(unique) )
+        return Observations([a.center_index for a in angles],
+                            [index_of[name] for name in names],
+                            [a.value for a in angles],
+                            unique)
+
+    @staticmethod
+    def from_distances(distances):
+        """Returns the observations contained in a list of Distance objects.
+        """
+        names  = [d.type1 + '-' + d.type2 for d in distances]
+        unique = sorted(set(names))
+        index_of = dict( (name, index) for index, name in enumerate(unique) )
+        return Observations([d.primary_index for d in distances],
+                            [index_of[name] for name in names],
+                            [d.value for d in distances],
+                            unique)
+
+
+
 def angle(A, O, B):
         """Return the angle between vectors OA and OB
 
@@ -144,63 +215,165 @@ class Structure:
         """Returns the distances between a given atom and its neighbors. (Sorted.)
         """
         return self.nbl.get_neighbor_distances(index, self.system, True)
+    
+    def get_bond_length_table(self):
+        """Returns the element types of all atoms and a table of bond lengths between the types.
+        
+        The types are integers indexing the sorted list of different chemical symbols in the system.
+        The table lists the stored bond length for every pair of types, or -1 if no bond
+        has been defined for the pair.
+        """
+        symbs = self.system.get_chemical_symbols()
+        elements = sorted(set(symbs))
+        type_of = dict( (elem, index) for index, elem in enumerate(elements) )
+        types = np.array([type_of[symb] for symb in symbs], dtype=int)
+        
+        table = -np.ones([len(elements), len(elements)])
+        for i, elem1 in enumerate(elements):
+            for j, elem2 in enumerate(elements):
+                length = self.get_bond_length([elem1,elem2])
+                if length is not None:
+                    table[i,j] = length
+        return types, table
+    
+    def get_all_bonds(self):
+        """Returns all bonded atom pairs as arrays.
+        
+        A pair is bonded if the atoms are closer than the stored bond length for their elements.
+        The bonds are returned as arrays (centers, neighbors, separations, distances) containing
+        the index of the central atom, the index of the neighbor, the separation vector and the distance
+        for each pair. The bonds are grouped by the central atom and sorted according to distance. 
+        All the separations and distances are calculated at once.
+        """
+        centers = self.nbl.get_neighbor_centers()
+        nbors = self.nbl.get_all_neighbors()[1]
+        vecs = self.nbl.get_all_neighbor_separations(self.system)
+        ds = np.sqrt(np.sum(vecs*vecs, axis=1))
+        
+        order = np.lexsort((ds, centers))
+        centers, nbors, vecs, ds = centers[order], nbors[order], vecs[order], ds[order]
+        
+        types, table = self.get_bond_length_table()
+        bonded = ds < table[types[centers], types[nbors]]
+        
+        return centers[bonded], nbors[bonded], vecs[bonded], ds[bonded]
         
+    def get_all_angle_arrays(self):
+        """Returns all 3-atom angles as arrays.
+
+        The angles are returned as arrays (centers, neighbors1, neighbors2, angles) containing
+        the index of the central atom, the indices of the two bonded neighbors and the angle
+        for each triplet. The angles are grouped by the central atom.
+        """
+        centers, nbors, vecs, ds = self.get_all_bonds()
+        
+        # the bonds of each atom are stored consecutively, so the
+        # pairs of bonds can be enumerated for all atoms with the
+        # same number of bonds at once
+        counts = np.bincount(centers, minlength=len(self.system))
+        starts = np.cumsum(counts) - counts
+        firsts = [np.zeros(0, dtype=int)]
+        seconds = [np.zeros(0, dtype=int)]
+        for count in np.unique(counts):
+            if count < 2:
+                continue
+            n1, n2 = np.tril_indices(count, -1)
+            atom_starts = starts[counts == count]
+            firsts.append( (atom_starts[:,np.newaxis] + n1).ravel() )
+            seconds.append( (atom_starts[:,np.newaxis] + n2).ravel() )
+                    
+        firsts = np.concatenate(firsts)
+        seconds = np.concatenate(seconds)
+        order = np.argsort(centers[firsts], kind='mergesort')
+        firsts, seconds = firsts[order], seconds[order]
+        
+        cosines = np.sum(vecs[firsts]*vecs[seconds], axis=1) / (ds[firsts]*ds[seconds])
+        values = np.arccos(np.clip(cosines, -1.0, 1.0))
+
+        return centers[firsts], nbors[firsts], nbors[seconds], values
+
+    def get_angle_observations(self):
+        """Returns all 3-atom angles as :class:`~pysic.utility.outliers.Observations`.
+
+        The labels are the chemical symbols of the three atoms in alphabetical order, 
+        as in :class:`~pysic.utility.outliers.Angle`. The angles are grouped by the central atom.
+        """
+        elements = sorted(set(self.system.get_chemical_symbols()))
+        types, table = self.get_bond_length_table()
+        centers, nbors1, nbors2, values = self.get_all_angle_arrays()
+        
+        # the types index the sorted list of elements, so sorting
+        # them puts the symbols in alphabetical order
+        triplets = np.sort(np.column_stack((types[centers], types[nbors1], types[nbors2])), axis=1)
+        n_types = len(elements)
+        codes = (triplets[:,0]*n_types + triplets[:,1])*n_types + triplets[:,2]
+        unique_codes, labels = np.unique(codes, return_inverse=True)
+        names = [ elements[code // (n_types*n_types)] + '-' + 
+                  elements[(code // n_types) % n_types] + '-' + 
+                  elements[code % n_types] for code in unique_codes ]
+
+        return Observations(centers, labels, values, names)
+        
+    def get_distance_observations(self):
+        """Returns all 2-atom distances as :class:`~pysic.utility.outliers.Observations`.
+
+        The labels are the chemical symbols of the two atoms in alphabetical order, 
+        as in :class:`~pysic.utility.outliers.Distance`. The distances are grouped by the central atom.
+        """
+
+        symbs = self.system.get_chemical_symbols()
+        elements = sorted(set(symbs))
+        types, table = self.get_bond_length_table()
+        centers, nbors, vecs, ds = self.get_all_bonds()
+
+        pairs = np.sort(np.column_stack((types[centers], types[nbors])), axis=1)
+        n_types = len(elements)
+        unique_codes, labels = np.unique(pairs[:,0]*n_types + pairs[:,1], return_inverse=True)
+        names = [ elements[code // n_types] + '-' + elements[code % n_types] for code in unique_codes ]
+
+        return Observations(centers, labels, ds, names)
+
     def get_all_angles(self):
         """Returns a list of all 3-atom angles as Angle objects.
+
+        For large structures, :meth:`~pysic.utility.outliers.Structure.get_angle_observations`
+        is much faster.
         """
         
-        angles = []
         symbs = self.system.get_chemical_symbols()
-        for atom in self.system:
-            nbors = self.get_neighbors(atom.index)
-            vecs = self.get_separations(atom.index)
-            ds = self.get_distances(atom.index)
-            centre = atom.symbol
-                
-            for n1 in range(len(nbors)):
-                for n2 in range(len(nbors)):
-                    if(n1 > n2):
-                        
-                        type1 = symbs[nbors[n1]]
-                        type2 = symbs[nbors[n2]]
-                        
-                        if(ds[n1] < self.get_bond_length([centre,type1]) and
-                            ds[n2] < self.get_bond_length([centre,type2])):
-                        
-                            new_angle = vec_angle(vecs[n1],vecs[n2])
-                            angles.append(Angle(atom.index,
-                                                atom.symbol,
-                                                type1,
-                                                type2,
-                                                new_angle))
+        centers, nbors1, nbors2, values = self.get_all_angle_arrays()
+        
+        angles = []
+        for center, nbor1, nbor2, value in zip(centers, nbors1, nbors2, values):
+            angles.append(Angle(center,
+                                symbs[center],
+                                symbs[nbor1],
+                                symbs[nbor2],
+                                value))
         return angles
                 
                 
     def get_all_distances(self):
         """Returns a list of all 2-atom distances as Distance objects.
+
+        For large structures, :meth:`~pysic.utility.outliers.Structure.get_distance_observations`
+        is much faster.
         """
         
-        dists = []
         symbs = self.system.get_chemical_symbols()
-        for atom in self.system:
-            
-            nbors = self.get_neighbors(atom.index)
-            ds = self.get_distances(atom.index)
-            type1 = atom.symbol
-            
-            for n1 in range(len(nbors)):
-                type2 = symbs[nbors[n1]]
-                        
-                if(ds[n1] < self.get_bond_length([type1,type2])):
-                    dists.append(Distance(atom.index,
-                                          type1,
-                                          type2,
-                                          ds[n1]))
+        centers, nbors, vecs, ds = self.get_all_bonds()
+        
+        dists = []
+        for center, nbor, dist in zip(centers, nbors, ds):
+            dists.append(Distance(center,
+                                  symbs[center],
+                                  symbs[nbor],
+                                  dist))
                                       
         return dists
     
     
-def get_distributions(angles, distances, radii):
+def get_distributions(angles, distances, radii, bins=100):
     """Return observed log-distributions of angles and distances
 
     Distributions are obtained for all combinations of observed atom types.
@@ -208,56 +381,102 @@ def get_distributions(angles, distances, radii):
     'angle.grid' and 'dist.grid'. The distributions are represented by
     vectors giving the log-probability of each "bin". These are not normalized
     by the "bin" widths. This is not a problem as these would cancel out later.
+
+    The observations may be given as lists of Angle and Distance objects,
+    as :class:`~pysic.utility.outliers.Observations`, or as lists of
+    Observations (e.g., one for each frame of a trajectory), in which
+    case the distributions are shared by all the sets.
+    """
+
+    angle_distribs = get_observation_distributions(as_observations(angles, Observations.from_angles), bins)
+    dist_distribs  = get_observation_distributions(as_observations(distances, Observations.from_distances), bins)
+
+    return angle_distribs, dist_distribs
+
+
+
+def as_observations(items, converter):
+    """Returns the given observations as a single Observations object.
+
+    Lists of Angle or Distance objects are converted with the given
+    function, and lists of Observations are concatenated.
+    """
+    if isinstance(items, Observations):
+        return items
+    items = list(items)
+    if len(items) > 0 and isinstance(items[0], Observations):
+        return Observations.concatenate(items)
+    return converter(items)
+
+
+
+def get_observation_distributions(observations, bins=100):
+    """Return log-distributions of the observations for each label.
+
+    All labels share the same grid of 'bins' bins, 
+    spanning the range of the observed values with a 1 % marginal.
     """
 
-    angle_distribs = {}
-    dist_distribs  = {}
+    distribs = {}
+    if len(observations) == 0:
+        return distribs
+    
+    grid_range = [0.99*observations.values.min(), 1.01*observations.values.max()]
 
-    min_angle, max_angle = np.inf, 0
-    for angle in angles:
-        if angle.value < min_angle: min_angle = angle.value
-        if angle.value > max_angle: max_angle = angle.value
+    # sort the values by label so that each label is a contiguous slice
+    order = np.argsort(observations.labels, kind='mergesort')
+    labels = observations.labels[order]
+    values = observations.values[order]
+    bounds = np.searchsorted(labels, np.arange(len(observations.label_names)+1))
     
-    for angle in angles:
-        label = angle.type1 + '-' + angle.type2 + '-' + angle.type3
-        if not label in angle_distribs.keys():
-            angle_distribs[label] = Distribution()
-        angle_distribs[label].items.append(angle.value)
-
-    for label in angle_distribs:
-        a, b = np.histogram(angle_distribs[label].items,
-                            bins=100, range=[0.99*min_angle, 1.01*max_angle])
+    for index, label in enumerate(observations.label_names):
+        if bounds[index] == bounds[index+1]:
+            continue
+        a, b = np.histogram(values[bounds[index]:bounds[index+1]], 
+                            bins=bins, range=grid_range)
         a = a.astype(np.float)
-        angle_distribs[label].grid = b
+        distribs[label] = Distribution()
+        distribs[label].grid = b
         with catch_warnings(): # ignore divbyzero-whining
             simplefilter('ignore')
-            angle_distribs[label].distribution = np.log(a / sum(a))
-        del(angle_distribs[label].items)
+            distribs[label].distribution = np.log(a / sum(a))
+        del(distribs[label].items)
 
+    return distribs
 
 
-    min_dist , max_dist  = np.inf, 0
-    for dist in distances:
-        if dist.value < min_dist: min_dist = dist.value
-        if dist.value > max_dist: max_dist = dist.value
 
-    for dist in distances:
-        label = dist.type1 + '-' + dist.type2
-        if not label in dist_distribs.keys():
-            dist_distribs[label] = Distribution()
-        dist_distribs[label].items.append(dist.value)
+def get_observation_log_likelihoods(observations, distribs, n_atoms):
+    """Calculate the log-likelihood contributions of the observations of each atom
 
-    for label in dist_distribs:
-        a, b = np.histogram(dist_distribs[label].items,
-                            bins=100, range=[0.99*min_dist, 1.01*max_dist])
-        a = a.astype(np.float)
-        dist_distribs[label].grid = b
-        with catch_warnings(): # ignore divbyzero-whining
-            simplefilter('ignore')
-            dist_distribs[label].distribution = np.log(a / sum(a))
-        del(dist_distribs[label].items)
+    Every observation is placed in its bin of the distribution of its label
+    and the log-probabilities of the bins are summed for each central atom.
+    Observations outside the grid do not contribute.
 
-    return angle_distribs, dist_distribs
+    Returns the sums and the numbers of observations for each atom.
+    """
+
+    contributions = np.zeros(len(observations))
+    for index, label in enumerate(observations.label_names):
+        selected = np.nonzero(observations.labels == index)[0]
+        if len(selected) == 0:
+            continue
+        grid = distribs[label].grid
+        distribution = distribs[label].distribution
+        values = observations.values[selected]
+        
+        # bins are closed on the left except for the last one, as in np.histogram
+        slots = np.searchsorted(grid, values, 'right') - 1
+        slots[values == grid[-1]] = len(grid) - 2
+        inside = (slots >= 0) & (slots < len(grid) - 1)
+        contributions[selected[inside]] = distribution[slots[inside]]
+
+    # empty distributions contain nan, which is ignored
+    contributions[np.isnan(contributions)] = 0.0
+
+    logls = np.bincount(observations.centers, weights=contributions, minlength=n_atoms)
+    counts = np.bincount(observations.centers, minlength=n_atoms)
+    return logls, counts
 
 
 
@@ -269,46 +488,80 @@ def get_log_likelihoods(angles, distances,angle_distribs,dist_distribs,n_atoms):
     'angle_distribs' and 'dist_distribs'' the histogram-based distributions
     and 'angle.grid' & 'dist.grid' the breakpoints of these histograms.
     Parameter 'n_atoms' gives the number of atoms in the original data.
+
+    The observations may be given as lists of Angle and Distance objects 
+    or as :class:`~pysic.utility.outliers.Observations`. The log-likelihoods
+    are the averages over the observations of each atom. Atoms without
+    any angles get -inf.
     """
 
-    angles    = np.array(angles)
-    distances = np.array(distances)
+    angles    = as_observations(angles, Observations.from_angles)
+    distances = as_observations(distances, Observations.from_distances)
+
+    a_sums, a_counts = get_observation_log_likelihoods(angles, angle_distribs, n_atoms)
+    d_sums, d_counts = get_observation_log_likelihoods(distances, dist_distribs, n_atoms)
 
     a_logls   = np.tile(-np.inf, n_atoms)
     d_logls   = np.tile(-np.inf, n_atoms)
 
-    for i in range(n_atoms): 
-        # All angles/distances originating from atom i
-        angleset = angles[np.array(map(lambda x: x.center_index, angles)) == i]
-        distset  = distances[np.array(
-                               map(lambda x: x.primary_index, distances)) == i]
-        if np.size(angleset) > 0:
-            a_logls[i] = 0
-            for angle in angleset:
-                label = angle.type1 + '-' + angle.type2 + '-' + angle.type3
-                slots = np.histogram(angle.value,
-                                     bins=angle_distribs[label].grid)[0]
-                with catch_warnings(): # ignore nan-whining
-                    simplefilter('ignore')
-                    a_logls[i] += np.nansum(angle_distribs[label].distribution *
-                                            slots)
-            a_logls[i] = a_logls[i] / np.size(angleset)
-
-            d_logls[i] = 0
-            for dist in distset:
-                label = dist.type1 + '-' + dist.type2
-                slots = np.histogram(dist.value,
-                                     bins=dist_distribs[label].grid)[0]
-                with catch_warnings(): # ignore nan-whining
-                    simplefilter('ignore')
-                    d_logls[i] += np.nansum(dist_distribs[label].distribution *
-                                            slots)
-            d_logls[i] = d_logls[i] / np.size(distset)
+    has_angles = a_counts > 0
+    a_logls[has_angles] = a_sums[has_angles] / a_counts[has_angles]
+    with catch_warnings(): # ignore divbyzero-whining
+        simplefilter('ignore')
+        d_logls[has_angles] = d_sums[has_angles] / d_counts[has_angles]
 
     return a_logls, d_logls
 
 
 
+def get_trajectory_log_likelihoods(frames, bonds, bins=100):
+    """Calculate log-likelihoods of each atom in each frame of a trajectory
+
+    The angles and distances are collected from all the frames and
+    the distributions are built from all of them, so that every frame is
+    compared to the same distributions. Only the observations
+    are kept in memory, so the frames may be given as an iterator
+    reading them one at a time.
+
+    Parameters:
+
+    frames: iterable of `ASE Atoms`_ objects
+        the structures to analyse
+    bonds: list of ([string, string], double) tuples
+        the pairs of elements and the cutoffs for bonds between them,
+        as given to :meth:`~pysic.utility.outliers.Structure.add_bond`
+    bins: integer
+        the number of bins in the distributions
+
+    Returns the angle and distance distributions and a list of
+    (a_logls, d_logls) pairs, one for each frame.
+    """
+
+    angles = []
+    distances = []
+    sizes = []
+    for frame in frames:
+        structure = Structure(frame)
+        for elements, cutoff in bonds:
+            structure.add_bond(elements, cutoff)
+        structure.create_neighbor_lists()
+        angles.append(structure.get_angle_observations())
+        distances.append(structure.get_distance_observations())
+        sizes.append(len(frame))
+
+    angle_distribs, dist_distribs = get_distributions(Observations.concatenate(angles), 
+                                                      Observations.concatenate(distances), 
+                                                      None, bins)
+
+    logls = []
+    for frame_angles, frame_distances, n_atoms in zip(angles, distances, sizes):
+        logls.append(get_log_likelihoods(frame_angles, frame_distances,
+                                         angle_distribs, dist_distribs, n_atoms))
+
+    return angle_distribs, dist_distribs, logls
+
+
+
 def write_to_file(filename, boxsize, atoms, coordinates, a_logls, d_logls):
     """Write original data + results into a file
 